@@ -60,22 +60,27 @@ _garimpeiro_forcar_temp_na_pasta_do_projeto()
 
 import streamlit as st
 import zipfile
+import zlib
 import io
 from contextlib import contextmanager
 import hashlib
 import base64
 import re
 import pandas as pd
+import numpy as np
 import random
 import gc
 import shutil
-from collections import Counter, defaultdict
+from collections import Counter, defaultdict, deque
 from calendar import monthrange
 from datetime import date, datetime
 import unicodedata
 import json
 import time
+from array import array
 import tempfile
+import threading
+import weakref
 import html as html_escape
 from pathlib import Path
 
@@ -761,6 +766,295 @@ def _zipfile_open_write_export(path: str):
     )
 
 
+# Membros à espera de entrar no .zip por thread de compressão (limita a memória dos XML já lidos).
+_ZIP_EXPORT_MEMBROS_EM_VOO_POR_WORKER = 8
+
+
+def _zip_export_workers() -> int:
+    """
+    Threads de compressão dos ZIP do pacote (o zlib liberta o GIL: comprimir sobrepõe-se à leitura e à escrita).
+    Variável GARIMPEIRO_ZIP_WORKERS: 0 ou 1 = série (`writestr` direto); N = N threads; em branco = automático
+    (núcleos, máx. 8; série na Streamlit Community Cloud).
+    """
+    raw = (os.environ.get("GARIMPEIRO_ZIP_WORKERS") or "").strip()
+    if raw:
+        try:
+            return max(1, min(int(raw), 32))
+        except ValueError:
+            return 1
+    if _streamlit_likely_community_cloud():
+        return 1
+    return max(1, min(os.cpu_count() or 1, 8))
+
+
+def _zip_membro_comprimido(dados, compresslevel: int) -> tuple:
+    """(crc, tamanho, bytes DEFLATE) de um membro — os mesmos bytes que `ZipFile.writestr` grava com este nível."""
+    comp = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    corpo = comp.compress(dados) + comp.flush()
+    return zlib.crc32(dados) & 0xFFFFFFFF, len(dados), corpo
+
+
+def _zip_membro_comprimido_de_ficheiro(caminho, compresslevel: int) -> tuple:
+    """
+    `_zip_membro_comprimido` de um ficheiro grande (Excel do pacote), por blocos: o corpo DEFLATE fica num
+    ``.deflate`` em `_excel_pasta_temp` (o 3.º elemento é esse caminho; apagar no fim) em vez de em memória.
+    """
+    destino = os.path.join(
+        _excel_pasta_temp(), f"{os.path.basename(os.fspath(caminho))}_{os.urandom(4).hex()}.deflate"
+    )
+    comp = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    crc = 0
+    tam = 0
+    with open(caminho, "rb") as fin, open(destino, "wb") as fout:
+        while True:
+            bloco = fin.read(1 << 20)
+            if not bloco:
+                break
+            crc = zlib.crc32(bloco, crc)
+            tam += len(bloco)
+            fout.write(comp.compress(bloco))
+        fout.write(comp.flush())
+    return crc & 0xFFFFFFFF, tam, destino
+
+
+# Atributos internos de `zipfile.ZipFile` que `_zip_acrescentar_comprimido` usa (sem eles: `writestr`).
+_ZIP_INTERNOS_ESCRITA = (
+    "_lock",
+    "_seekable",
+    "_writing",
+    "_writecheck",
+    "_didModify",
+    "start_dir",
+    "fp",
+    "filelist",
+    "NameToInfo",
+)
+
+
+def _zip_acrescentar_comprimido(zf, nome: str, dados, membro) -> None:
+    """
+    Acrescenta a `zf` um membro já comprimido — de `_zip_membro_comprimido` (ou `_zip_membro_comprimido_de_ficheiro`,
+    com o corpo num ficheiro copiado por blocos) ou copiado tal qual do ZIP de origem (`_zip_membro_bruto`, que traz
+    também o método e a data) — com o cabeçalho que `writestr` escreveria.
+    Só em ZIP DEFLATE com seek e sem ZIP64; fora disso (ou se a API interna mudar) usa `writestr` (`write` se
+    `dados` for um caminho), descomprimindo o membro bruto quando `dados` é None.
+    Usa atributos internos do `zipfile` (validado em CPython 3.11 e 3.13): se faltar algum, vai para `writestr`
+    antes de escrever; um erro a meio não estraga o ZIP porque `start_dir` só avança no fim e `writestr` grava
+    a partir dele.
+    """
+    crc, tam, corpo = membro[:3]
+    metodo = membro[3] if len(membro) > 3 else zipfile.ZIP_DEFLATED
+    data_hora = membro[4] if len(membro) > 4 else time.localtime(time.time())[:6]
+    corpo_em_ficheiro = isinstance(corpo, (str, os.PathLike))
+    try:
+        n_corpo = os.path.getsize(corpo) if corpo_em_ficheiro else len(corpo)
+        if (
+            not all(hasattr(zf, a) for a in _ZIP_INTERNOS_ESCRITA)
+            or not zf._seekable
+            or zf._writing
+            or zf.compression != zipfile.ZIP_DEFLATED
+            or tam * 1.05 > zipfile.ZIP64_LIMIT
+            or n_corpo > zipfile.ZIP64_LIMIT
+        ):
+            raise ValueError
+        zinfo = zipfile.ZipInfo(filename=nome, date_time=data_hora)
+        zinfo.compress_type = metodo
+        zinfo.external_attr = 0o600 << 16
+        zinfo.flag_bits = 0
+        zinfo.file_size = tam
+        zinfo.compress_size = n_corpo
+        zinfo.CRC = crc
+        with zf._lock:
+            zf.fp.seek(zf.start_dir)
+            zinfo.header_offset = zf.fp.tell()
+            zf._writecheck(zinfo)
+            zf._didModify = True
+            zf.fp.write(zinfo.FileHeader(False))
+            if corpo_em_ficheiro:
+                with open(corpo, "rb") as fc:
+                    shutil.copyfileobj(fc, zf.fp, 1 << 20)
+            else:
+                zf.fp.write(corpo)
+            zf.start_dir = zf.fp.tell()
+            zf.filelist.append(zinfo)
+            zf.NameToInfo[zinfo.filename] = zinfo
+    except (AttributeError, TypeError, ValueError):
+        if isinstance(dados, (str, os.PathLike)):
+            zf.write(os.fspath(dados), nome)
+        else:
+            zf.writestr(nome, dados if dados is not None else _zip_membro_bruto_dados(membro))
+
+
+def _zip_membro_local(fp, offset: int, compress_size: int, crc: int, file_size: int, nome: str | None = None):
+    """
+    (crc, tamanho, bytes comprimidos, método, data) do membro cujo cabeçalho local está em `offset` de `fp`,
+    lido sem descomprimir. `crc`/tamanhos vêm do diretório central (o cabeçalho local pode tê-los a zero).
+    None se o cabeçalho não bater certo (assinatura, nome quando indicado), o membro estiver cifrado ou o
+    método não for DEFLATE/STORED.
+    """
+    fp.seek(offset)
+    cab = fp.read(30)
+    if len(cab) != 30 or cab[:4] != b"PK\x03\x04":
+        return None
+    flags = int.from_bytes(cab[6:8], "little")
+    metodo = int.from_bytes(cab[8:10], "little")
+    if flags & 0x1 or metodo not in (zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED):
+        return None
+    t_dos = int.from_bytes(cab[10:12], "little")
+    d_dos = int.from_bytes(cab[12:14], "little")
+    n_nome = int.from_bytes(cab[26:28], "little")
+    n_extra = int.from_bytes(cab[28:30], "little")
+    if nome is not None:
+        nome_local = fp.read(n_nome).decode("utf-8" if flags & 0x800 else "cp437", errors="replace")
+        if nome_local != nome:
+            return None
+    fp.seek(offset + 30 + n_nome + n_extra)
+    corpo = fp.read(compress_size)
+    if len(corpo) != compress_size:
+        return None
+    data_hora = (
+        (d_dos >> 9) + 1980,
+        (d_dos >> 5) & 0xF,
+        d_dos & 0x1F,
+        t_dos >> 11,
+        (t_dos >> 5) & 0x3F,
+        (t_dos & 0x1F) * 2,
+    )
+    return crc, file_size, corpo, metodo, data_hora
+
+
+def _zip_membro_verificar(membro) -> None:
+    """
+    Confere CRC e tamanho de um membro comprimido descomprimindo-o por blocos (sem guardar o XML):
+    `zipfile.BadZipFile` se não baterem, como faria `zf.read`.
+    """
+    crc, tam, corpo, metodo = membro[:4]
+    if metodo == zipfile.ZIP_STORED:
+        calc, n = zlib.crc32(corpo), len(corpo)
+    else:
+        dec = zlib.decompressobj(-15)
+        calc = n = 0
+        vista = memoryview(corpo)
+        try:
+            for i in range(0, len(vista), 1 << 18):
+                bloco = dec.decompress(vista[i : i + (1 << 18)])
+                calc = zlib.crc32(bloco, calc)
+                n += len(bloco)
+            bloco = dec.flush()
+        except zlib.error as e:
+            raise zipfile.BadZipFile(str(e)) from e
+        calc = zlib.crc32(bloco, calc)
+        n += len(bloco)
+        if not dec.eof:
+            raise zipfile.BadZipFile("membro DEFLATE truncado")
+    if n != tam or (calc & 0xFFFFFFFF) != crc:
+        raise zipfile.BadZipFile("CRC ou tamanho do membro não confere")
+
+
+def _zip_membro_bruto(zf, nome: str):
+    """
+    (crc, tamanho, bytes comprimidos, método, data) de um membro DEFLATE **tal como está** no ZIP de origem,
+    sem o voltar a comprimir. None se o método for outro (STORED também: copiado tal qual o pacote ficava sem
+    compressão), o membro estiver cifrado ou o cabeçalho local não bater certo — quem chama lê então com
+    `zf.read`. O fluxo é descomprimido uma vez para conferir o CRC (`_zip_membro_verificar`): um membro
+    corrompido dá `zipfile.BadZipFile`, como com `zf.read`, em vez de passar tal qual para o ZIP exportado.
+    """
+    try:
+        zi = zf.getinfo(nome)
+        if zi.compress_type != zipfile.ZIP_DEFLATED or zi.flag_bits & 0x1:
+            return None
+        membro = _zip_membro_local(zf.fp, zi.header_offset, zi.compress_size, zi.CRC, zi.file_size, zi.filename)
+    except (KeyError, OSError, ValueError, AttributeError):
+        return None
+    if membro is None:
+        return None
+    _zip_membro_verificar(membro)
+    return membro
+
+
+def _zip_membro_bruto_dados(membro) -> bytes:
+    """Bytes descomprimidos de um membro de `_zip_membro_bruto` (com verificação de tamanho e CRC)."""
+    crc, tam, corpo, metodo = membro[:4]
+    try:
+        dados = corpo if metodo == zipfile.ZIP_STORED else zlib.decompress(corpo, -15)
+    except zlib.error as e:
+        raise zipfile.BadZipFile(str(e)) from e
+    if len(dados) != tam or (zlib.crc32(dados) & 0xFFFFFFFF) != crc:
+        raise zipfile.BadZipFile("CRC ou tamanho do membro não confere")
+    return dados
+
+
+def _zip_gravar_membro(zf, nome: str, dados, bruto=None) -> None:
+    """`writestr`, ou cópia direta do membro comprimido do ZIP de origem quando há `bruto`."""
+    if bruto is not None:
+        _zip_acrescentar_comprimido(zf, nome, dados, bruto)
+    else:
+        zf.writestr(nome, dados)
+
+
+def _zip_export_escritor():
+    """
+    Escritor partilhado pelos ZIP de uma exportação. `gravar(zf, nome, dados, bruto=None)` manda comprimir numa
+    thread (ou, com `bruto` de `_zip_membro_bruto`, copia o membro já comprimido) e os membros entram em cada
+    .zip pela ordem dos pedidos; `escoar()` grava o que está pendente (obrigatório antes
+    de escrever outra coisa num .zip ou de o fechar); `fechar()` escoa e pára as threads. Com 1 worker grava logo
+    com `writestr`, como antes.
+    """
+    nivel = _zip_export_compresslevel()
+    workers = _zip_export_workers()
+    pool = None
+    if workers > 1:
+        try:
+            from concurrent.futures import ThreadPoolExecutor
+
+            pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="garimpo_zip")
+        except Exception:
+            pool = None
+    pendentes = deque()  # (zf, nome, dados, future | membro já comprimido)
+    max_em_voo = max(1, workers * _ZIP_EXPORT_MEMBROS_EM_VOO_POR_WORKER)
+
+    def _escrever_um():
+        zf, nome, dados, fut = pendentes.popleft()
+        if isinstance(fut, tuple):
+            _zip_acrescentar_comprimido(zf, nome, dados, fut)
+            return
+        try:
+            membro = fut.result()
+        except Exception:
+            zf.writestr(nome, dados)
+            return
+        _zip_acrescentar_comprimido(zf, nome, dados, membro)
+
+    def gravar(zf, nome, dados, bruto=None):
+        if bruto is not None:
+            # Membro copiado do ZIP de origem: sem compressão; entra na fila só para manter a ordem.
+            if pendentes:
+                pendentes.append((zf, nome, dados, bruto))
+            else:
+                _zip_acrescentar_comprimido(zf, nome, dados, bruto)
+            return
+        if pool is None:
+            zf.writestr(nome, dados)
+            return
+        pendentes.append((zf, nome, dados, pool.submit(_zip_membro_comprimido, dados, nivel)))
+        while len(pendentes) > max_em_voo:
+            _escrever_um()
+
+    def escoar():
+        while pendentes:
+            _escrever_um()
+
+    def fechar():
+        try:
+            escoar()
+        finally:
+            pendentes.clear()
+            if pool is not None:
+                pool.shutdown(wait=True, cancel_futures=True)
+
+    return {"gravar": gravar, "escoar": escoar, "fechar": fechar, "nivel": nivel}
+
+
 def _lista_ficheiros_pasta_uploads():
     """
     Só ficheiros em TEMP_UPLOADS_DIR (ignora subpastas).
@@ -778,7 +1072,8 @@ def _lista_ficheiros_pasta_uploads():
         return []
 
 
-# Bytes dos XML/ZIP do lote atual (garimpo + «incluir mais»), quando não se grava em disco local.
+# Fontes do lote atual (garimpo + «incluir mais») quando não se grava em disco local: nome -> caminho no spool
+# temporário da sessão (ou bytes, em sessões antigas / fallback).
 SESSION_KEY_FONTES_XML_MEMORIA = "_garimpo_fontes_xml_memoria"
 # SHA-256 de ficheiros já incorporados ao lote via «Incluir mais» (evita duplicar a cada rerun / duplo Processar).
 SESSION_KEY_EXTRA_DIGESTS = "_garimpo_extra_sha256_vistos"
@@ -882,7 +1177,7 @@ def _session_state_pop_garimpo(key):
 def _garimpo_analise_sem_pasta_local_projeto() -> bool:
     """
     True (omissão): durante a análise **não** grava uploads em `temp_garimpo_uploads` na pasta do projeto —
-    mantém os bytes na sessão Streamlit até nova análise. Exportações ZIP/Excel continuam a ir para a pasta **que escolher**.
+    guarda-os no spool temporário da sessão (TEMP, com quota e limpeza automática) até nova análise. Exportações ZIP/Excel continuam a ir para a pasta **que escolher**.
     Defina `GARIMPEIRO_ANALISE_SEM_DISCO_LOCAL=0` para voltar a gravar no disco (lotes muito grandes e pouca RAM).
     """
     v = os.environ.get("GARIMPEIRO_ANALISE_SEM_DISCO_LOCAL", "1").strip().lower()
@@ -891,6 +1186,195 @@ def _garimpo_analise_sem_pasta_local_projeto() -> bool:
 
 def _garimpo_limpar_fontes_xml_memoria_sessao():
     _session_state_pop_garimpo(SESSION_KEY_FONTES_XML_MEMORIA)
+    _garimpo_spool_limpar_sessao()
+
+
+# --- SPOOL DO LOTE (modo «sem disco local») ---
+# Cada ZIP/XML do lote é copiado em blocos para um ficheiro temporário da sessão (fora da pasta do projeto) e
+# SESSION_KEY_FONTES_XML_MEMORIA guarda só o caminho — a RAM deixa de crescer com o tamanho do lote.
+# Valores `bytes` (sessões antigas / fallback sem disco) continuam a ser aceites por quem lê.
+SESSION_KEY_GARIMPO_SPOOL_ID = "_garimpo_spool_id"
+SESSION_KEY_GARIMPO_SPOOL_BYTES = "_garimpo_spool_bytes"
+# Quota por sessão (omissão 8 GB) e espaço livre mínimo a deixar no disco (omissão 1 GB).
+_GARIMPO_SPOOL_MAX_BYTES_SESSAO = int(
+    os.environ.get("GARIMPEIRO_SPOOL_MAX_BYTES_SESSAO", str(8 * 1024 * 1024 * 1024))
+)
+_GARIMPO_SPOOL_DISCO_LIVRE_MIN = int(
+    os.environ.get("GARIMPEIRO_SPOOL_DISCO_LIVRE_MIN_BYTES", str(1024 * 1024 * 1024))
+)
+# Spools de sessões sem acesso há mais do que isto (browser fechado) são apagados.
+_GARIMPO_SPOOL_TTL_SEG = int(float(os.environ.get("GARIMPEIRO_SPOOL_TTL_HORAS", "24") or 24) * 3600)
+_GARIMPO_SPOOL_BLOCO_COPIA = 1024 * 1024
+_garimpo_spool_ultima_varredura = [0.0]
+
+
+def _garimpo_spool_raiz() -> str:
+    """Pasta-mãe dos spools (GARIMPEIRO_SPOOL_DIR; omissão: TEMP, já desviado para a pasta de dados)."""
+    env = (os.environ.get("GARIMPEIRO_SPOOL_DIR") or "").strip().strip('"').strip("'")
+    return os.path.abspath(env) if env else os.path.join(tempfile.gettempdir(), "garimpeiro_spool")
+
+
+def _garimpo_spool_varrer_abandonados(excepto: str | None = None) -> None:
+    """Apaga spools de outras sessões parados há mais de GARIMPEIRO_SPOOL_TTL_HORAS (no máx. 1×/10 min)."""
+    agora = time.time()
+    if agora - _garimpo_spool_ultima_varredura[0] < 600:
+        return
+    _garimpo_spool_ultima_varredura[0] = agora
+    try:
+        for ent in os.scandir(_garimpo_spool_raiz()):
+            if not ent.is_dir() or ent.name == excepto:
+                continue
+            try:
+                if agora - ent.stat().st_mtime > _GARIMPO_SPOOL_TTL_SEG:
+                    shutil.rmtree(ent.path, ignore_errors=True)
+            except OSError:
+                continue
+    except OSError:
+        pass
+
+
+def _garimpo_spool_dir_sessao(criar: bool = True) -> str | None:
+    """Pasta de spool desta sessão (id aleatório guardado na sessão); None se não existe e `criar` é falso."""
+    sid = _session_state_get_garimpo(SESSION_KEY_GARIMPO_SPOOL_ID)
+    if not sid:
+        if not criar:
+            return None
+        sid = f"{int(time.time())}_{os.urandom(6).hex()}"
+        try:
+            st.session_state[SESSION_KEY_GARIMPO_SPOOL_ID] = sid
+        except Exception:
+            return None
+    d = os.path.join(_garimpo_spool_raiz(), str(sid))
+    if criar:
+        os.makedirs(d, exist_ok=True)
+        _garimpo_spool_varrer_abandonados(excepto=str(sid))
+    return d
+
+
+def _garimpo_spool_limpar_sessao() -> None:
+    """Apaga o spool desta sessão (novo garimpo / limpeza) e zera a contagem da quota."""
+    d = _garimpo_spool_dir_sessao(criar=False)
+    if d:
+        shutil.rmtree(d, ignore_errors=True)
+    _session_state_pop_garimpo(SESSION_KEY_GARIMPO_SPOOL_BYTES)
+
+
+def _garimpo_tamanho_origem(origem) -> int:
+    """Tamanho em bytes de UploadedFile / ficheiro aberto / Path / bytes, sem ler o conteúdo."""
+    if isinstance(origem, (bytes, bytearray, memoryview)):
+        return len(origem)
+    if isinstance(origem, (str, Path)):
+        return os.path.getsize(origem)
+    n = getattr(origem, "size", None)
+    if isinstance(n, int):
+        return n
+    pos = origem.tell()
+    origem.seek(0, os.SEEK_END)
+    n = origem.tell()
+    origem.seek(pos)
+    return n
+
+
+def _garimpo_spool_gravar(mem: dict, key: str, origem) -> bool:
+    """
+    Copia `origem` (UploadedFile, ficheiro aberto, Path ou bytes) em blocos para o spool da sessão e regista
+    `mem[key] = caminho`. Devolve False — nada registado — se passar a quota da sessão ou deixar o disco abaixo
+    do mínimo livre. Se o disco falhar (permissões, etc.) guarda os bytes em `mem`, como antes do spool.
+    """
+    try:
+        n = _garimpo_tamanho_origem(origem)
+    except (OSError, ValueError, AttributeError):
+        n = 0
+    usados = int(_session_state_get_garimpo(SESSION_KEY_GARIMPO_SPOOL_BYTES, 0) or 0)
+    if usados + n > _GARIMPO_SPOOL_MAX_BYTES_SESSAO:
+        return False
+    tmp = None
+    try:
+        pasta = _garimpo_spool_dir_sessao()
+        if pasta is None:
+            raise OSError("sessão sem id de spool")
+        if shutil.disk_usage(pasta).free - n < _GARIMPO_SPOOL_DISCO_LIVRE_MIN:
+            return False
+        destino = os.path.join(pasta, key)
+        tmp = destino + ".parcial"
+        if isinstance(origem, (str, Path)):
+            shutil.copyfile(origem, tmp)
+        elif isinstance(origem, (bytes, bytearray, memoryview)):
+            with open(tmp, "wb") as out_f:
+                out_f.write(origem)
+        else:
+            origem.seek(0)
+            with open(tmp, "wb") as out_f:
+                shutil.copyfileobj(origem, out_f, _GARIMPO_SPOOL_BLOCO_COPIA)
+        os.replace(tmp, destino)
+    except OSError:
+        try:
+            if isinstance(origem, (str, Path)):
+                mem[key] = Path(origem).read_bytes()
+            elif isinstance(origem, (bytes, bytearray, memoryview)):
+                mem[key] = bytes(origem)
+            else:
+                origem.seek(0)
+                mem[key] = origem.read()
+            return True
+        except (OSError, ValueError, AttributeError):
+            return False
+    finally:
+        if tmp is not None:
+            try:
+                os.remove(tmp)  # só existe se a cópia falhou antes do os.replace
+            except OSError:
+                pass
+    mem[key] = destino
+    try:
+        st.session_state[SESSION_KEY_GARIMPO_SPOOL_BYTES] = usados + n
+    except Exception:
+        pass
+    return True
+
+
+def _garimpo_spool_desfazer(mem: dict, keys) -> None:
+    """Retira `keys` de `mem`, apaga os ficheiros do spool correspondentes e devolve o tamanho à quota."""
+    libertados = 0
+    for key in keys:
+        v = mem.pop(key, None)
+        if isinstance(v, str):
+            try:
+                libertados += os.path.getsize(v)
+                os.remove(v)
+            except OSError:
+                pass
+    if libertados:
+        usados = int(_session_state_get_garimpo(SESSION_KEY_GARIMPO_SPOOL_BYTES, 0) or 0)
+        try:
+            st.session_state[SESSION_KEY_GARIMPO_SPOOL_BYTES] = max(0, usados - libertados)
+        except Exception:
+            pass
+
+
+def _garimpo_spool_aviso_recusados(n_recusados: int) -> None:
+    """Aviso único quando ficheiros ficaram fora do lote por quota / disco."""
+    if n_recusados <= 0:
+        return
+    _q = _GARIMPO_SPOOL_MAX_BYTES_SESSAO / (1024.0**3)
+    st.warning(
+        f"**{n_recusados}** ficheiro(s) não entraram no lote: ultrapassam a quota temporária desta sessão "
+        f"(~**{_q:.0f} GB**) ou o disco do servidor ficaria quase cheio. Divida o lote ou ajuste "
+        "`GARIMPEIRO_SPOOL_MAX_BYTES_SESSAO` / `GARIMPEIRO_SPOOL_DISCO_LIVRE_MIN_BYTES`."
+    )
+
+
+def _garimpo_sha256_origem(origem) -> str:
+    """SHA-256 do conteúdo lido em blocos (sem `getvalue()` de uma só vez)."""
+    h = hashlib.sha256()
+    origem.seek(0)
+    while True:
+        b = origem.read(_GARIMPO_SPOOL_BLOCO_COPIA)
+        if not b:
+            break
+        h.update(b)
+    origem.seek(0)
+    return h.hexdigest()
 
 
 def _garimpo_nome_chave_upload(indice: int, nome_original: str) -> str:
@@ -919,14 +1403,26 @@ def _garimpo_existem_fontes_xml_lote():
 
 @contextmanager
 def _abrir_fonte_xml_garimpo_stream(f_name: str):
-    """Abre um ficheiro do lote: da memória da sessão ou de TEMP_UPLOADS_DIR."""
+    """
+    Abre um ficheiro do lote: spool da sessão (caminho), bytes na sessão ou TEMP_UPLOADS_DIR.
+    Devolve sempre um objeto de ficheiro com seek — o zipfile lê só os membros de que precisa.
+    """
     mem = _session_state_get_garimpo(SESSION_KEY_FONTES_XML_MEMORIA)
     if (
         _garimpo_analise_sem_pasta_local_projeto()
         and isinstance(mem, dict)
         and f_name in mem
     ):
-        bio = io.BytesIO(mem[f_name])
+        v = mem[f_name]
+        if isinstance(v, str):
+            try:
+                os.utime(os.path.dirname(v))  # mantém o spool «vivo» para a varredura por TTL
+            except OSError:
+                pass
+            with open(v, "rb") as f:
+                yield f
+            return
+        bio = io.BytesIO(v)
         try:
             yield bio
         finally:
@@ -955,20 +1451,23 @@ def _garimpo_absorver_uploads_extra_no_lote(extra_files) -> int:
             mem = _session_state_get_garimpo(SESSION_KEY_FONTES_XML_MEMORIA)
             if not isinstance(mem, dict):
                 mem = {}
+            n_recusados = 0
             for f in files:
                 try:
-                    raw = f.getvalue()
+                    d = _garimpo_sha256_origem(f)
                 except Exception:
                     continue
-                d = hashlib.sha256(raw).hexdigest()
                 if d in seen:
                     continue
-                seen.add(d)
                 key = _garimpo_nome_chave_upload(len(mem), getattr(f, "name", None) or "extra")
-                mem[key] = raw
+                if not _garimpo_spool_gravar(mem, key, f):
+                    n_recusados += 1
+                    continue
+                seen.add(d)
                 n_new += 1
             if n_new:
                 st.session_state[SESSION_KEY_FONTES_XML_MEMORIA] = mem
+            _garimpo_spool_aviso_recusados(n_recusados)
         else:
             os.makedirs(TEMP_UPLOADS_DIR, exist_ok=True)
             start_i = len(_lista_ficheiros_pasta_uploads())
@@ -1016,8 +1515,8 @@ def _garimpo_mostrar_campo_pasta_lote_entrada() -> bool:
 
 def _garimpo_importar_lote_de_pasta_servidor(entrada: Path, mem_accum: dict) -> tuple[int, str | None]:
     """
-    Varre `entrada` (recursivo), copia cada .xml/.zip para TEMP_UPLOADS_DIR ou para `mem_accum` (bytes).
-    Devolve (número de ficheiros, mensagem de erro ou None).
+    Varre `entrada` (recursivo), copia cada .xml/.zip para TEMP_UPLOADS_DIR ou para o spool da sessão
+    (`mem_accum` fica com os caminhos). Devolve (número de ficheiros, mensagem de erro ou None).
     """
     if not entrada.is_dir():
         return 0, "O caminho não é uma pasta acessível no servidor."
@@ -1035,18 +1534,38 @@ def _garimpo_importar_lote_de_pasta_servidor(entrada: Path, mem_accum: dict) ->
     if not paths:
         return 0, None
     use_mem = _garimpo_analise_sem_pasta_local_projeto()
+    # Se parar a meio, o que já foi copiado nesta chamada sai (spool + quota, ou TEMP_UPLOADS_DIR).
+    copiados = []
+    erro = None
     try:
         if not use_mem:
             os.makedirs(TEMP_UPLOADS_DIR, exist_ok=True)
         for i, src in enumerate(paths, start=1):
             key = _garimpo_nome_chave_upload(i, src.name)
             if use_mem:
-                mem_accum[key] = src.read_bytes()
+                if not _garimpo_spool_gravar(mem_accum, key, src):
+                    erro = (
+                        f"O lote ultrapassa a quota temporária da sessão ou o espaço livre do servidor (em «{src.name}»)."
+                    )
+                    break
+                copiados.append(key)
             else:
-                shutil.copy2(src, os.path.join(TEMP_UPLOADS_DIR, key))
+                destino = os.path.join(TEMP_UPLOADS_DIR, key)
+                copiados.append(destino)
+                shutil.copy2(src, destino)
     except OSError as e:
-        return 0, str(e)
-    return len(paths), None
+        erro = str(e)
+    if erro is None:
+        return len(paths), None
+    if use_mem:
+        _garimpo_spool_desfazer(mem_accum, copiados)
+    else:
+        for destino in copiados:
+            try:
+                os.remove(destino)
+            except OSError:
+                pass
+    return 0, erro
 
 
 def _erro_caminho_windows_num_servidor_nao_windows(s: str) -> str | None:
@@ -1185,53 +1704,39 @@ def _garimpo_destino_copia_lote_opcional():
 
 
 def _garimpo_df_e_filtro_espelho_so_sped_se_anexado(
-    df_geral: pd.DataFrame, texto_sped_sessao: str | None
+    df_geral: pd.DataFrame, texto_sped_sessao
 ):
     """
-    Se existir texto SPED (C100/D100 com CHV), o export para pasta/ZIP espelha **só** documentos cuja
+    Se existir SPED (texto ou ficheiro de `_sped_fonte_sessao`; C100/D100 com CHV), o export para pasta/ZIP espelha **só** documentos cuja
     chave 44 está nesse SPED — mesmo que o lido no garimpo seja maior.
     Sem SPED ou sem chaves extraídas do ficheiro → mantém o relatório completo.
     Devolve (df_para_export, filtro_chaves).
     """
     if df_geral is None or getattr(df_geral, "empty", True) or "Chave" not in df_geral.columns:
         return df_geral, set()
-    filtro_full = {
-        k
-        for k in (_chave_para_conjunto_export(x) for x in df_geral["Chave"].tolist())
-        if k
-    }
-    t = (texto_sped_sessao or "").strip()
-    if not t:
+    chaves = _df_vista_chaves(df_geral)["chave"]
+    filtro_full = {k for k in chaves if k}
+    if _sped_fonte_vazia(texto_sped_sessao):
         return df_geral, filtro_full
-    sped44 = set(_sped_chaves44_de_texto(t))
+    sped44 = _sped_tabela(texto_sped_sessao)["conj44"]
     if not sped44:
         return df_geral, filtro_full
-
-    def _row_ch44_no_sped(row) -> bool:
-        d44 = _chave44_digitos(row.get("Chave"))
-        return bool(d44 and d44 in sped44)
-
-    mask = df_geral.apply(_row_ch44_no_sped, axis=1)
+    mask = df_geral["Chave"].map(_chave44_digitos).isin(sped44).to_numpy(dtype=bool)
     df_f = df_geral.loc[mask].reset_index(drop=True)
-    filtro_f = {
-        k
-        for k in (_chave_para_conjunto_export(x) for x in df_f["Chave"].tolist())
-        if k
-    }
+    filtro_f = {k for k in chaves[mask] if k}
     return df_f, filtro_f
 
 
 def _garimpo_registar_aviso_sped_chaves_sem_xml_no_lote(
-    df_geral_full: pd.DataFrame, texto_sped: str
+    df_geral_full: pd.DataFrame, texto_sped
 ) -> None:
     """
     Se há SPED com chaves C100/D100, compara com o que entrou no relatório geral (lote lido).
     Chaves do SPED sem XML no lote → DataFrame em sessão (`SPED_FALTANTES_XML_DF_KEY`) e Excel
     `SPED_chaves_sem_XML_no_lote.xlsx` gravado na primeira pasta acessível (pasta do 1.º passo, pai do espelho ou pasta de dados).
     """
-    t = (texto_sped or "").strip()
     if (
-        not t
+        _sped_fonte_vazia(texto_sped)
         or df_geral_full is None
         or getattr(df_geral_full, "empty", True)
         or "Chave" not in df_geral_full.columns
@@ -1240,19 +1745,15 @@ def _garimpo_registar_aviso_sped_chaves_sem_xml_no_lote(
         st.session_state.pop(SPED_FALTANTES_XML_DF_KEY, None)
         st.session_state.pop(SPED_FALTANTES_XLSX_PATH_KEY, None)
         return
-    sped44 = set(_sped_chaves44_de_texto(t))
+    sped44 = _sped_tabela(texto_sped)["conj44"]
     if not sped44:
         st.session_state.pop("_garimpo_aviso_sped_nao_lidas", None)
         st.session_state.pop(SPED_FALTANTES_XML_DF_KEY, None)
         st.session_state.pop(SPED_FALTANTES_XLSX_PATH_KEY, None)
         return
-    lidas_44 = set()
-    for x in df_geral_full["Chave"].tolist():
-        d = _chave44_digitos(x)
-        if d:
-            lidas_44.add(d)
+    lidas_44 = set(df_geral_full["Chave"].map(_chave44_digitos).dropna())
     matched_ch = sped44 & lidas_44
-    df_falt = _dataframe_sped_chaves_sem_xml_no_lote(t, matched_ch)
+    df_falt = _dataframe_sped_chaves_sem_xml_no_lote(texto_sped, matched_ch)
     falt = sped44 - lidas_44
     if not falt or df_falt is None or getattr(df_falt, "empty", True):
         st.session_state.pop("_garimpo_aviso_sped_nao_lidas", None)
@@ -1271,69 +1772,36 @@ def _garimpo_registar_aviso_sped_chaves_sem_xml_no_lote(
         st.session_state.pop(SPED_FALTANTES_XLSX_PATH_KEY, None)
 
 
-def _garimpo_exportar_zips_pacote_contab_pasta_base(
-    root_espelho: Path,
-    stem_org: str,
-    filtro_chaves: set,
-    cnpj_limpo: str,
-    xb_completo,
-    df_geral: pd.DataFrame,
-) -> None:
-    """
-    Gera os .zip do padrão contabilidade **dentro** da subpasta do espelho (`Garimpeiro_Local_…`, ao lado das pastas abertas),
-    para o utilizador encontrar tudo no mesmo sítio (híbrido / rede). Respeita o modo **Recursivo / Domínio** do ZIP (`SESSION_KEY_GARIMPO_EXTRACAO_ZIP`), alinhado com o espelho em pastas.
-    """
-    try:
-        base = Path(root_espelho).resolve()
-        if not base or not str(base).strip():
-            return
-        base.mkdir(parents=True, exist_ok=True)
-        _v2_export_pacote_contab_por_dimensoes(
-            base,
-            stem_org,
-            filtro_chaves,
-            cnpj_limpo,
-            xb_completo,
-            _PACOTE_CONTAB_NOME_EXCEL_RAIZ,
-            df_geral,
-        )
-    except Exception as e:
-        try:
-            st.session_state["_garimpo_export_zip_erro"] = str(e)
-        except Exception:
-            pass
-
-
 def _garimpo_gravar_excel_todo_o_lote_lido_sped(
-    root: Path, stem_org: str, df_sessao_completo: pd.DataFrame, texto_sped: str
+    root: Path, stem_org: str, df_sessao_completo: pd.DataFrame, texto_sped
 ) -> None:
     """
     Com SPED anexado, o pacote em pastas/ZIP segue só as chaves C100/D100 — pode excluir terceiros fora do SPED.
     Grava um Excel extra com **todo** o `df_geral` da sessão (tudo o que foi lido), para arquivo paralelo.
     """
-    if not (texto_sped or "").strip():
+    if _sped_fonte_vazia(texto_sped):
         return
     if df_sessao_completo is None or getattr(df_sessao_completo, "empty", True):
         return
     try:
-        xb_all = _xb_completo_pacote_contabilidade_de_df_geral(df_sessao_completo)
-        if not xb_all:
-            return
         stem_safe = _v2_sanitize_nome_export(stem_org, max_len=80) or "pacote_apuracao"
         nome = _v2_sanitize_nome_export(
             f"{stem_safe}_relatorio_garimpeiro_todo_o_lote_lido.xlsx", max_len=200
         ) or f"{stem_safe}_relatorio_garimpeiro_todo_o_lote_lido.xlsx"
         if not str(nome).lower().endswith(".xlsx"):
             nome = f"{nome}.xlsx"
-        p = root / nome
-        raw = xb_all if isinstance(xb_all, (bytes, bytearray)) else bytes(xb_all)
-        with open(p, "wb") as wf:
-            wf.write(raw)
+        xb_all = _xb_completo_pacote_contabilidade_de_df_geral(df_sessao_completo)
+        if not xb_all:
+            return
+        try:
+            _excel_fonte_gravar(xb_all, root / nome)
+        finally:
+            _excel_fonte_descartar(xb_all)
     except OSError:
         pass
 
 
-def _garimpo_export_pack_espelho_pastas_xml_se_aplicavel(
+def _garimpo_espelho_exportar_pastas_e_zips(
     root: Path,
     stem_org: str,
     filtro_chaves: set,
@@ -1343,37 +1811,63 @@ def _garimpo_export_pack_espelho_pastas_xml_se_aplicavel(
     prev_idx,
 ):
     """
-    Espelho em **pastas** com XML (Recursivo/Domínio) ou **só ZIP** (`apenas_zip`: sem subpastas de XML no disco).
+    Espelho em **pastas** com XML (Recursivo/Domínio; delta face a `prev_idx` quando possível) e os .zip do pacote
+    contabilidade na mesma subpasta (`Garimpeiro_Local_…`), alimentados por **uma** leitura do lote.
+    Com **Só ZIP** (`apenas_zip`) não há subpastas de XML no disco. Os ZIP respeitam o modo Recursivo / Domínio
+    de `SESSION_KEY_GARIMPO_EXTRACAO_ZIP`; uma falha neles fica em `_garimpo_export_zip_erro` sem parar as pastas.
     Devolve o mesmo 6-tuple que `_v2_export_pacote_contab_em_pasta`.
     """
+    destino_pastas = None
     if _garimpo_extracao_pasta_espelho() == "apenas_zip":
         try:
             st.session_state.pop("garimpo_espelho_indice_td", None)
         except Exception:
             pass
-        return [], [], 0, None, None, {}
-    pack = None
-    if isinstance(prev_idx, dict) and prev_idx:
-        pack = _v2_export_pacote_contab_em_pasta_delta(
-            root,
-            stem_org,
-            filtro_chaves,
-            cnpj_limpo,
-            xb_completo,
-            _PACOTE_CONTAB_NOME_EXCEL_RAIZ,
-            df_filtrado,
-            prev_idx,
-        )
-    if pack is None:
-        pack = _v2_export_pacote_contab_em_pasta(
-            root,
-            stem_org,
-            filtro_chaves,
-            cnpj_limpo,
-            xb_completo,
-            _PACOTE_CONTAB_NOME_EXCEL_RAIZ,
-            df_filtrado,
+    else:
+        if isinstance(prev_idx, dict) and prev_idx:
+            destino_pastas = _pacote_contab_destino_pasta_delta(
+                root,
+                stem_org,
+                filtro_chaves,
+                cnpj_limpo,
+                xb_completo,
+                df_filtrado,
+                prev_idx,
+            )
+        if destino_pastas is None:
+            destino_pastas = _pacote_contab_destino_pasta(
+                root, stem_org, filtro_chaves, xb_completo, df_filtrado
+            )
+    destino_zips = None
+    try:
+        base = Path(root).resolve()
+        base.mkdir(parents=True, exist_ok=True)
+        destino_zips = _pacote_contab_destino_zip(
+            base, stem_org, filtro_chaves, xb_completo, df_filtrado
         )
+        destino_zips["tolerante"] = True
+    except Exception as e:
+        try:
+            st.session_state["_garimpo_export_zip_erro"] = str(e)
+        except Exception:
+            pass
+    _export_lote_passagem_unica(cnpj_limpo, [destino_pastas, destino_zips])
+    pack = (
+        destino_pastas["fechar"]()
+        if destino_pastas is not None
+        else ([], [], 0, None, None, {})
+    )
+    if destino_zips is not None:
+        erro_zip = destino_zips.get("erro")
+        try:
+            destino_zips["fechar"]()
+        except Exception as e:
+            erro_zip = erro_zip or str(e)
+        if erro_zip:
+            try:
+                st.session_state["_garimpo_export_zip_erro"] = erro_zip
+            except Exception:
+                pass
     return pack
 
 
@@ -1381,7 +1875,7 @@ def _garimpo_gravar_espelho_layout_contabilidade(cnpj_limpo: str) -> bool:
     """
     Após o df_geral estar na sessão: opcionalmente grava na subpasta do espelho (Garimpeiro_Local_…) pastas por grupo
     (Recursivo / Domínio) ou **só** ficheiros `.zip` + Excel se escolher **Só ZIP** no passo 3.
-    Gera sempre os .zip do pacote na mesma pasta (critério ZIP do passo 3).
+    Gera sempre os .zip do pacote na mesma pasta (critério ZIP do passo 3); pastas e ZIPs saem da mesma leitura do lote.
     Com SPED: pastas/ZIP seguem só chaves C100/D100; grava-se também `…_relatorio_garimpeiro_todo_o_lote_lido.xlsx`
     com **todo** o lido na sessão (inclui terceiros que o SPED não cruze).
     Devolve True se correu até ao fim; em falha define `st.session_state['_garimpo_espelho_gravacao_erro']` e devolve False.
@@ -1395,7 +1889,7 @@ def _garimpo_gravar_espelho_layout_contabilidade(cnpj_limpo: str) -> bool:
     cnpj = "".join(c for c in str(cnpj_limpo or "") if c.isdigit())[:14]
     if len(cnpj) != 14:
         return True
-    texto_sped = str(st.session_state.get("sped_efd_texto_sessao") or "").strip()
+    texto_sped = _sped_fonte_sessao()
     df_filtrado, filtro_chaves = _garimpo_df_e_filtro_espelho_so_sped_se_anexado(
         df_sessao, texto_sped
     )
@@ -1413,15 +1907,12 @@ def _garimpo_gravar_espelho_layout_contabilidade(cnpj_limpo: str) -> bool:
         pass
     prev_idx = st.session_state.get("garimpo_espelho_indice_td")
     try:
-        pack = _garimpo_export_pack_espelho_pastas_xml_se_aplicavel(
+        pack = _garimpo_espelho_exportar_pastas_e_zips(
             root, stem_org, filtro_chaves, cnpj, xb_completo, df_filtrado, prev_idx
         )
         _paths, _e, _xm, _av, _xls, indice = pack
         if isinstance(indice, dict) and indice:
             st.session_state["garimpo_espelho_indice_td"] = indice
-        _garimpo_exportar_zips_pacote_contab_pasta_base(
-            root, stem_org, filtro_chaves, cnpj, xb_completo, df_filtrado
-        )
         _garimpo_gravar_excel_todo_o_lote_lido_sped(
             root, stem_org, df_sessao, texto_sped
         )
@@ -1436,6 +1927,8 @@ def _garimpo_gravar_espelho_layout_contabilidade(cnpj_limpo: str) -> bool:
         except Exception:
             pass
         return False
+    finally:
+        _excel_fonte_descartar(xb_completo)
 
 
 def _garimpo_resync_espelho_completo(cnpj_limpo: str) -> tuple[bool, str]:
@@ -1456,7 +1949,7 @@ def _garimpo_resync_espelho_completo(cnpj_limpo: str) -> tuple[bool, str]:
     nomes = _lista_nomes_fontes_xml_garimpo()
     if not nomes:
         return False, "Nenhuma fonte no lote."
-    texto_sped = str(st.session_state.get("sped_efd_texto_sessao") or "").strip()
+    texto_sped = _sped_fonte_sessao()
     df_filtrado, filtro_chaves = _garimpo_df_e_filtro_espelho_so_sped_se_anexado(
         df_sessao, texto_sped
     )
@@ -1472,20 +1965,19 @@ def _garimpo_resync_espelho_completo(cnpj_limpo: str) -> tuple[bool, str]:
     except Exception:
         pass
     try:
-        pack = _garimpo_export_pack_espelho_pastas_xml_se_aplicavel(
+        pack = _garimpo_espelho_exportar_pastas_e_zips(
             root, stem_org, filtro_chaves, cnpj, xb_completo, df_filtrado, prev_idx
         )
         _paths, _empty, xm, av, _xls, indice = pack
         if isinstance(indice, dict) and indice:
             st.session_state["garimpo_espelho_indice_td"] = indice
-        _garimpo_exportar_zips_pacote_contab_pasta_base(
-            root, stem_org, filtro_chaves, cnpj, xb_completo, df_filtrado
-        )
         _garimpo_gravar_excel_todo_o_lote_lido_sped(
             root, stem_org, df_sessao, texto_sped
         )
     except Exception as e:
         return False, str(e)
+    finally:
+        _excel_fonte_descartar(xb_completo)
     _zip_err = None
     try:
         _zip_err = st.session_state.pop("_garimpo_export_zip_erro", None)
@@ -1654,23 +2146,40 @@ def _montar_mapa_chave_slug_contab(df: pd.DataFrame, chaves_permitidas: set) ->
     out = {}
     if df is None or df.empty or "Chave" not in df.columns or not chaves_permitidas:
         return out
-    for _, row in df.iterrows():
-        k = _chave_para_conjunto_export(row.get("Chave"))
-        if not k or k not in chaves_permitidas:
-            continue
-        is_pr = _origem_row_e_propria(row.get("Origem", ""))
-        mod = row.get("Modelo", "") or row.get("Tipo", "")
-        ano = row["Ano"] if "Ano" in row.index else None
-        mes = row["Mes"] if "Mes" in row.index else None
-        slug = _pacote_contab_slug_emitidas_com_mes(
-            is_pr,
-            row.get("Status Final", ""),
-            row.get("Série", "0"),
-            mod,
-            ano,
-            mes,
-            row.get("Operação") or row.get("Operacao"),
-        )
+    chaves = _df_vista_chaves(df)["chave"]
+    pos = np.flatnonzero(pd.Series(chaves).isin(chaves_permitidas).to_numpy())
+    if not len(pos):
+        return out
+
+    def col(nome, padrao):
+        if nome in df.columns:
+            return df[nome].to_numpy(dtype=object)[pos]
+        return np.full(len(pos), padrao, dtype=object)
+
+    # O slug depende de poucas combinações (origem, status, série, modelo, mês, operação): calcula-se uma vez
+    # por combinação e o resto das linhas só consulta o memo.
+    memo = {}
+    for k, combo in zip(
+        chaves[pos],
+        zip(
+            col("Origem", ""),
+            col("Status Final", ""),
+            col("Série", "0"),
+            col("Modelo", ""),
+            col("Tipo", ""),
+            col("Ano", None),
+            col("Mes", None),
+            col("Operação", None),
+            col("Operacao", None),
+        ),
+    ):
+        slug = memo.get(combo)
+        if slug is None:
+            origem, stt, serie, modelo, tipo, ano, mes, op, op_alt = combo
+            slug = _pacote_contab_slug_emitidas_com_mes(
+                _origem_row_e_propria(origem), stt, serie, modelo or tipo, ano, mes, op or op_alt
+            )
+            memo[combo] = slug
         out[k] = slug
     return out
 
@@ -1702,45 +2211,54 @@ def _nota_int_de_linha_relatorio(row):
 
 def _pacote_contab_notas_min_max_por_slug(df_ref, mapa_slug: dict, filtro_chaves: set) -> dict:
     """slug â†’ (n_min, n_max) com base no DataFrame de referência (para sufixo _notas_ no nome do .zip)."""
-    mm = defaultdict(lambda: [None, None])
     if df_ref is None or getattr(df_ref, "empty", True) or not filtro_chaves:
         return {}
     if "Chave" not in df_ref.columns:
         return {}
-    for _, row in df_ref.iterrows():
-        k = _chave_para_conjunto_export(row["Chave"] if "Chave" in row.index else None)
-        if not k or k not in filtro_chaves:
-            continue
-        slug = mapa_slug.get(k)
-        if not slug:
-            continue
-        n = _nota_int_de_linha_relatorio(row)
-        if n is None:
-            continue
-        lo, hi = mm[slug]
-        mm[slug][0] = n if lo is None else min(lo, n)
-        mm[slug][1] = n if hi is None else max(hi, n)
-    return {s: (lo, hi) for s, (lo, hi) in mm.items() if lo is not None and hi is not None}
+    chaves = pd.Series(_df_vista_chaves(df_ref)["chave"])
+    slugs = chaves.map(mapa_slug).where(chaves.isin(filtro_chaves))
+    pos = np.flatnonzero(slugs.notna().to_numpy() & slugs.astype(bool).to_numpy())
+    if not len(pos):
+        return {}
+
+    def _int_ou_none(n):
+        if pd.isna(n):
+            return None
+        try:
+            return int(float(n))
+        except (TypeError, ValueError):
+            return None
 
+    # Mesma precedência de `_nota_int_de_linha_relatorio`: Número, Num_Faltante, posições 25–33 da chave.
+    nota = np.full(len(pos), np.nan)
+    for c in ("Número", "Num_Faltante"):
+        if c in df_ref.columns:
+            falta = np.isnan(nota)
+            nota[falta] = _serie_por_valores_unicos(df_ref[c].iloc[pos], _int_ou_none).astype("float64")[falta]
+    falta = np.isnan(nota)
+    if falta.any():
+        ch = chaves.iloc[pos].where(falta).astype(object)
+        ok = ch.map(lambda c: isinstance(c, str) and len(c) == 44 and c.isdigit()).to_numpy(dtype=bool)
+        nota[ok] = ch[ok].str[25:34].astype("int64").to_numpy()
+    g = pd.DataFrame({"slug": slugs.iloc[pos].to_numpy(), "n": nota}).dropna()
+    if g.empty:
+        return {}
+    agg = g.groupby("slug", sort=False)["n"].agg(["min", "max"])
+    return {s: (int(lo), int(hi)) for s, lo, hi in zip(agg.index, agg["min"], agg["max"])}
 
-def _v2_export_pacote_contab_por_dimensoes(
+
+def _pacote_contab_destino_zip(
     out_dir: Path,
     stem_org: str,
     filtro_chaves: set,
-    cnpj_limpo: str,
     xb_completo,
-    excel_fn_completo: str,
     df_ref: pd.DataFrame,
 ):
     """
-    ZIP por emitida (status Ã— sÃ©rie Ã— **mÃªs**) ou por terceiros (modelo Ã— status Ã— **mÃªs** de emissão).
-    Dentro de cada ZIP: pasta XML/Lote_001, Lote_002, … (até MAX_XML_PER_ZIP XML por pasta)
-    + Excel na raiz com nome único por grupo (`relatorio_garimpeiro_<slug>.xlsx`). Nome do .zip pode incluir _notas_min_max.
-    Com extração de lote «domínio»: XML só na **raiz** (sem ``XML/Lote_…``). Por grupo (slug), no máximo
-    ``MAX_XML_PER_ZIP`` XML por ficheiro; cada parte fecha-se com o Excel e renomeia-se com ``_notas_min_max``
-    **só desse ZIP** (ex.: 1–10 000, 10 001–20 000). O Excel completo de **todo** o lote continua **solto** em ``out_dir``.
-    Grava também o Excel completo **solto** em out_dir (prefixo = stem_org).
-    Devolve (paths, [], matched, aviso, caminho_excel_solta|None).
+    Destino ZIP do pacote contabilidade para `_export_lote_passagem_unica` (mesmas regras de slug, dedupe e
+    partes que `_v2_export_pacote_contab_por_dimensoes`). Os XML que vêm de ZIP são copiados já comprimidos
+    (`aceita_bruto`). `fechar()` sela os ZIP abertos, grava o Excel solto e devolve
+    (paths, [], matched, aviso, caminho_excel_solta|None).
     """
     mapa_slug = _montar_mapa_chave_slug_contab(df_ref, filtro_chaves)
     slug_ranges = _pacote_contab_notas_min_max_por_slug(df_ref, mapa_slug, filtro_chaves)
@@ -1753,6 +2271,21 @@ def _v2_export_pacote_contab_por_dimensoes(
     slug_zip_count = {}
     _dom_paths_temp: dict = {}
     _dom_nota_mm: dict = {}
+    # XML comprimidos em threads; o Excel (igual em todos os ZIP) comprime-se uma vez só.
+    escritor = _zip_export_escritor()
+    excel_membro = []
+
+    def _excel_no_zip(zf, slug_excel):
+        if not xb_completo:
+            return
+        if not excel_membro:
+            if _excel_fonte_e_ficheiro(xb_completo):
+                excel_membro.append(_zip_membro_comprimido_de_ficheiro(xb_completo, escritor["nivel"]))
+            else:
+                excel_membro.append(_zip_membro_comprimido(xb_completo, escritor["nivel"]))
+        _zip_acrescentar_comprimido(
+            zf, _nome_excel_pacote_contab_dentro_zip(slug_excel), xb_completo, excel_membro[0]
+        )
 
     def _dom_res_numero(res) -> int | None:
         try:
@@ -1777,11 +2310,11 @@ def _v2_export_pacote_contab_por_dimensoes(
         zf = zips_abertos.pop(k_dom, None)
         if zf is None:
             return
+        escritor["escoar"]()
         tmp = _dom_paths_temp.pop(k_dom, None)
         slug_excel = k_dom[0] if isinstance(k_dom, tuple) else k_dom
         try:
-            if xb_completo:
-                zf.writestr(_nome_excel_pacote_contab_dentro_zip(slug_excel), xb_completo)
+            _excel_no_zip(zf, slug_excel)
         except OSError:
             pass
         try:
@@ -1851,99 +2384,125 @@ def _v2_export_pacote_contab_por_dimensoes(
         _dom_paths_temp[k] = tmp
         return zf
 
-    xml_matched = 0
+    cont = {"xml_matched": 0}
     chaves_ja_gravadas_pacote = set()
-    for f_name in _lista_nomes_fontes_xml_garimpo():
-        with _abrir_fonte_xml_garimpo_stream(f_name) as f_temp:
-            for name, xml_data in extrair_recursivo(f_temp, f_name):
-                res, is_p = identify_xml_info(xml_data, cnpj_limpo, name)
-                ck = _chave_para_conjunto_export(res["Chave"]) if res else None
-                if res and ck and ck in filtro_chaves:
-                    td = _tupla_dedupe_export_xml(res, ck)
-                    if td is None or td in chaves_ja_gravadas_pacote:
-                        del xml_data
-                        continue
-                    chaves_ja_gravadas_pacote.add(td)
-                    xml_matched += 1
-                    slug = mapa_slug.get(ck) or _pacote_contab_slug_emitidas_com_mes(
-                        is_p,
-                        str(res.get("Status") or "NORMAIS"),
-                        res.get("Série", "0"),
-                        res.get("Tipo", "Outros"),
-                        res.get("Ano"),
-                        res.get("Mes"),
-                        res.get("Operacao"),
-                    )
-                    nome_xml = _nome_arquivo_xml_contabilidade(res, name)
-                    if _zip_dom:
-                        part = slug_zip_part.get(slug, 0)
-                        k = (slug, part)
-                        n = slug_zip_count.get(k, 0)
-                        if n >= MAX_XML_PER_ZIP:
-                            _dominio_seal_zip(k)
-                            part += 1
-                            slug_zip_part[slug] = part
-                            k = (slug, part)
-                            n = 0
-                        zf = _dominio_abrir_zip_parte(slug, part)
-                        zf.writestr(nome_xml, xml_data)
-                        _dom_touch_nota(k, res)
-                        slug_zip_count[k] = n + 1
-                    else:
-                        zf = _ensure_zip(slug)
-                        _pfx = _prefixo_lote_xml(slug)
-                        _inner = f"{_pfx}/{nome_xml}"
-                        zf.writestr(_inner, xml_data)
-                del xml_data
 
-    if _zip_dom:
-        for k_rem in list(zips_abertos.keys()):
-            _dominio_seal_zip(k_rem)
-    else:
-        for z_key, zf in zips_abertos.items():
-            slug_excel = z_key[0] if isinstance(z_key, tuple) else z_key
-            try:
-                if xb_completo:
-                    zf.writestr(
-                        _nome_excel_pacote_contab_dentro_zip(slug_excel), xb_completo
-                    )
-            except OSError:
-                pass
+    def _gravar(name, xml_data, res, is_p, bruto=None):
+        ck = _chave_para_conjunto_export(res["Chave"])
+        if ck and ck in filtro_chaves:
+            td = _tupla_dedupe_export_xml(res, ck)
+            if td is None or td in chaves_ja_gravadas_pacote:
+                return
+            chaves_ja_gravadas_pacote.add(td)
+            cont["xml_matched"] += 1
+            slug = mapa_slug.get(ck) or _pacote_contab_slug_emitidas_com_mes(
+                is_p,
+                str(res.get("Status") or "NORMAIS"),
+                res.get("Série", "0"),
+                res.get("Tipo", "Outros"),
+                res.get("Ano"),
+                res.get("Mes"),
+                res.get("Operacao"),
+            )
+            nome_xml = _nome_arquivo_xml_contabilidade(res, name)
+            if _zip_dom:
+                part = slug_zip_part.get(slug, 0)
+                k = (slug, part)
+                n = slug_zip_count.get(k, 0)
+                if n >= MAX_XML_PER_ZIP:
+                    _dominio_seal_zip(k)
+                    part += 1
+                    slug_zip_part[slug] = part
+                    k = (slug, part)
+                    n = 0
+                zf = _dominio_abrir_zip_parte(slug, part)
+                escritor["gravar"](zf, nome_xml, xml_data, bruto)
+                _dom_touch_nota(k, res)
+                slug_zip_count[k] = n + 1
+            else:
+                zf = _ensure_zip(slug)
+                _pfx = _prefixo_lote_xml(slug)
+                _inner = f"{_pfx}/{nome_xml}"
+                escritor["gravar"](zf, _inner, xml_data, bruto)
+
+    def _fechar():
+        try:
+            escritor["escoar"]()
+            if _zip_dom:
+                for k_rem in list(zips_abertos.keys()):
+                    _dominio_seal_zip(k_rem)
+            else:
+                for z_key, zf in zips_abertos.items():
+                    slug_excel = z_key[0] if isinstance(z_key, tuple) else z_key
+                    try:
+                        _excel_no_zip(zf, slug_excel)
+                    except OSError:
+                        pass
+                    try:
+                        zf.close()
+                    except OSError:
+                        pass
+        finally:
+            escritor["fechar"]()
+            if excel_membro and _excel_fonte_e_ficheiro(excel_membro[0][2]):
+                _excel_fonte_descartar(excel_membro[0][2])
+
+        excel_solta_path = None
+        if xb_completo:
             try:
-                zf.close()
+                out_dir.mkdir(parents=True, exist_ok=True)
+                stem_safe = _v2_sanitize_nome_export(stem_org, max_len=80) or "pacote_apuracao"
+                nome_xlsx = _v2_sanitize_nome_export(
+                    f"{stem_safe}_{_PACOTE_CONTAB_NOME_EXCEL_RAIZ}", max_len=200
+                ) or _PACOTE_CONTAB_NOME_EXCEL_RAIZ
+                if not str(nome_xlsx).lower().endswith(".xlsx"):
+                    nome_xlsx = f"{nome_xlsx}.xlsx"
+                p_x = out_dir / nome_xlsx
+                _excel_fonte_gravar(xb_completo, p_x)
+                excel_solta_path = str(p_x.resolve())
             except OSError:
-                pass
+                excel_solta_path = None
 
-    excel_solta_path = None
-    if xb_completo:
-        try:
-            out_dir.mkdir(parents=True, exist_ok=True)
-            stem_safe = _v2_sanitize_nome_export(stem_org, max_len=80) or "pacote_apuracao"
-            nome_xlsx = _v2_sanitize_nome_export(
-                f"{stem_safe}_{_PACOTE_CONTAB_NOME_EXCEL_RAIZ}", max_len=200
-            ) or _PACOTE_CONTAB_NOME_EXCEL_RAIZ
-            if not str(nome_xlsx).lower().endswith(".xlsx"):
-                nome_xlsx = f"{nome_xlsx}.xlsx"
-            p_x = out_dir / nome_xlsx
-            _raw = (
-                xb_completo
-                if isinstance(xb_completo, (bytes, bytearray))
-                else bytes(xb_completo)
+        aviso = None
+        if cont["xml_matched"] == 0:
+            aviso = (
+                "Nenhum XML em disco correspondeu às chaves. "
+                "Causas frequentes: pasta do garimpo apagada, ou chaves na tabela que não batem com os ficheiros."
             )
-            with open(p_x, "wb") as xf:
-                xf.write(_raw)
-            excel_solta_path = str(p_x.resolve())
-        except OSError:
-            excel_solta_path = None
+        _paths_list = sorted(paths_ordered.values(), key=lambda p: os.path.basename(p).lower())
+        return _paths_list, [], cont["xml_matched"], aviso, excel_solta_path
 
-    aviso = None
-    if xml_matched == 0:
-        aviso = (
-            "Nenhum XML em disco correspondeu às chaves. "
-            "Causas frequentes: pasta do garimpo apagada, ou chaves na tabela que não batem com os ficheiros."
-        )
-    _paths_list = sorted(paths_ordered.values(), key=lambda p: os.path.basename(p).lower())
-    return _paths_list, [], xml_matched, aviso, excel_solta_path
+    return {
+        "filtro": lambda r, _p: _chave_para_conjunto_export(r.get("Chave")) in filtro_chaves,
+        "gravar": _gravar,
+        "aceita_bruto": True,
+        "fechar": _fechar,
+    }
+
+
+def _v2_export_pacote_contab_por_dimensoes(
+    out_dir: Path,
+    stem_org: str,
+    filtro_chaves: set,
+    cnpj_limpo: str,
+    xb_completo,
+    excel_fn_completo: str,
+    df_ref: pd.DataFrame,
+):
+    """
+    ZIP por emitida (status Ã— sÃ©rie Ã— **mÃªs**) ou por terceiros (modelo Ã— status Ã— **mÃªs** de emissão).
+    Dentro de cada ZIP: pasta XML/Lote_001, Lote_002, … (até MAX_XML_PER_ZIP XML por pasta)
+    + Excel na raiz com nome único por grupo (`relatorio_garimpeiro_<slug>.xlsx`). Nome do .zip pode incluir _notas_min_max.
+    Com extração de lote «domínio»: XML só na **raiz** (sem ``XML/Lote_…``). Por grupo (slug), no máximo
+    ``MAX_XML_PER_ZIP`` XML por ficheiro; cada parte fecha-se com o Excel e renomeia-se com ``_notas_min_max``
+    **só desse ZIP** (ex.: 1–10 000, 10 001–20 000). O Excel completo de **todo** o lote continua **solto** em ``out_dir``.
+    Grava também o Excel completo **solto** em out_dir (prefixo = stem_org).
+    Devolve (paths, [], matched, aviso, caminho_excel_solta|None).
+    """
+    del excel_fn_completo
+    destino = _pacote_contab_destino_zip(out_dir, stem_org, filtro_chaves, xb_completo, df_ref)
+    _export_lote_passagem_unica(cnpj_limpo, [destino])
+    return destino["fechar"]()
 
 
 def _td_chave_serial(td: tuple) -> str:
@@ -1954,12 +2513,16 @@ def _td_chave_serial(td: tuple) -> str:
 
 
 def _xb_completo_pacote_contabilidade_de_df_geral(df_geral: pd.DataFrame):
-    """Mesma lógica de Excel do pacote contabilidade (Etapa 3 / matriz): relatório sem Painel Fiscal."""
+    """
+    Mesma lógica de Excel do pacote contabilidade (Etapa 3 / matriz): relatório sem Painel Fiscal.
+    Devolve o caminho do .xlsx na cache de relatórios (`_excel_fonte_descartar` no fim, para o caso de ser um
+    temporário) ou, no recurso sem xlsxwriter, os bytes.
+    """
     if df_geral is None or getattr(df_geral, "empty", True):
         return None
     xb_completo = None
     try:
-        xb_completo = excel_relatorio_geral_com_dashboard_bytes(
+        xb_completo = excel_relatorio_geral_com_dashboard_cache(
             df_geral, incluir_painel_fiscal=False
         )
     except Exception:
@@ -1969,23 +2532,18 @@ def _xb_completo_pacote_contabilidade_de_df_geral(df_geral: pd.DataFrame):
     return xb_completo
 
 
-def _v2_export_pacote_contab_em_pasta(
+def _pacote_contab_destino_pasta(
     out_dir: Path,
     stem_org: str,
     filtro_chaves: set,
-    cnpj_limpo: str,
     xb_completo,
-    excel_fn_completo: str,
     df_ref: pd.DataFrame,
 ):
     """
-    Igual a _v2_export_pacote_contab_por_dimensoes, mas grava em disco pastas com o mesmo conteúdo
-    que cada .zip descompactado (Excel + XML). **Recursivo:** `XML/Lote_NNN/…`; **Domínio:** XML soltos na pasta do grupo.
-    O nome de cada pasta é `<nome_base>__<grupo>` (sem sufixo `_notas_…`, ao contrário do .zip exportado).
-    Devolve (paths pastas, [], matched, aviso, caminho_excel_solta|None, indice_td_paths).
-    indice_td_paths: td_serial -> {"path": rel, "slug": str}.
+    Destino «pastas do espelho» para `_export_lote_passagem_unica` (ver `_v2_export_pacote_contab_em_pasta`).
+    Limpa `out_dir` ao ser criado — antes de qualquer outro destino gravar na mesma pasta.
+    `fechar()` grava os Excel e devolve o 6-tuple com o índice td → caminho.
     """
-    del excel_fn_completo  # paridade com a função ZIP; nome solto usa _PACOTE_CONTAB_NOME_EXCEL_RAIZ
     try:
         if out_dir.exists():
             for ch in list(out_dir.iterdir()):
@@ -2032,98 +2590,112 @@ def _v2_export_pacote_contab_em_pasta(
         slug_in_lote[slug] += 1
         return f"{PACOTE_CONTAB_PASTA_MAE_XML}/Lote_{li:03d}"
 
-    xml_matched = 0
+    cont = {"xml_matched": 0}
     chaves_ja_gravadas_pacote = set()
     indice_td = {}
-    for f_name in _lista_nomes_fontes_xml_garimpo():
-        with _abrir_fonte_xml_garimpo_stream(f_name) as f_temp:
-            for name, xml_data in extrair_recursivo(f_temp, f_name):
-                res, is_p = identify_xml_info(xml_data, cnpj_limpo, name)
-                ck = _chave_para_conjunto_export(res["Chave"]) if res else None
-                if res and ck and ck in filtro_chaves:
-                    td = _tupla_dedupe_export_xml(res, ck)
-                    if td is None or td in chaves_ja_gravadas_pacote:
-                        del xml_data
-                        continue
-                    chaves_ja_gravadas_pacote.add(td)
-                    xml_matched += 1
-                    slug = mapa_slug.get(ck) or _pacote_contab_slug_emitidas_com_mes(
-                        is_p,
-                        str(res.get("Status") or "NORMAIS"),
-                        res.get("Série", "0"),
-                        res.get("Tipo", "Outros"),
-                        res.get("Ano"),
-                        res.get("Mes"),
-                        res.get("Operacao"),
-                    )
-                    folder = _ensure_pasta(slug)
-                    _nm = _nome_arquivo_xml_contabilidade(res, name)
-                    if _pasta_plano_dominio:
-                        _inner = _nm
-                        dest = folder / _nm
-                    else:
-                        _pfx = _prefixo_lote_xml(slug)
-                        _inner = f"{_pfx}/{_nm}"
-                        dest = folder / Path(_inner.replace("/", os.sep))
-                    try:
-                        dest.parent.mkdir(parents=True, exist_ok=True)
-                        dest.write_bytes(xml_data)
-                        try:
-                            indice_td[_td_chave_serial(td)] = {
-                                "path": str(dest.relative_to(out_dir)).replace(
-                                    "\\", "/"
-                                ),
-                                "slug": slug,
-                            }
-                        except ValueError:
-                            pass
-                    except OSError:
-                        pass
-                del xml_data
 
-    for slug, folder in pastas_abertos.items():
-        try:
-            if xb_completo:
-                xn = _nome_excel_pacote_contab_dentro_zip(slug)
-                _raw = (
-                    xb_completo
-                    if isinstance(xb_completo, (bytes, bytearray))
-                    else bytes(xb_completo)
-                )
-                (folder / xn).write_bytes(_raw)
-        except OSError:
-            pass
+    def _gravar(name, xml_data, res, is_p):
+        ck = _chave_para_conjunto_export(res["Chave"])
+        if ck and ck in filtro_chaves:
+            td = _tupla_dedupe_export_xml(res, ck)
+            if td is None or td in chaves_ja_gravadas_pacote:
+                return
+            chaves_ja_gravadas_pacote.add(td)
+            cont["xml_matched"] += 1
+            slug = mapa_slug.get(ck) or _pacote_contab_slug_emitidas_com_mes(
+                is_p,
+                str(res.get("Status") or "NORMAIS"),
+                res.get("Série", "0"),
+                res.get("Tipo", "Outros"),
+                res.get("Ano"),
+                res.get("Mes"),
+                res.get("Operacao"),
+            )
+            folder = _ensure_pasta(slug)
+            _nm = _nome_arquivo_xml_contabilidade(res, name)
+            if _pasta_plano_dominio:
+                _inner = _nm
+                dest = folder / _nm
+            else:
+                _pfx = _prefixo_lote_xml(slug)
+                _inner = f"{_pfx}/{_nm}"
+                dest = folder / Path(_inner.replace("/", os.sep))
+            try:
+                dest.parent.mkdir(parents=True, exist_ok=True)
+                dest.write_bytes(xml_data)
+                try:
+                    indice_td[_td_chave_serial(td)] = {
+                        "path": str(dest.relative_to(out_dir)).replace(
+                            "\\", "/"
+                        ),
+                        "slug": slug,
+                    }
+                except ValueError:
+                    pass
+            except OSError:
+                pass
 
-    excel_solta_path = None
-    if xb_completo:
-        try:
-            out_dir.mkdir(parents=True, exist_ok=True)
-            stem_safe = _v2_sanitize_nome_export(stem_org, max_len=80) or "pacote_apuracao"
-            nome_xlsx = _v2_sanitize_nome_export(
-                f"{stem_safe}_{_PACOTE_CONTAB_NOME_EXCEL_RAIZ}", max_len=200
-            ) or _PACOTE_CONTAB_NOME_EXCEL_RAIZ
-            if not str(nome_xlsx).lower().endswith(".xlsx"):
-                nome_xlsx = f"{nome_xlsx}.xlsx"
-            p_x = out_dir / nome_xlsx
-            _raw = (
-                xb_completo
-                if isinstance(xb_completo, (bytes, bytearray))
-                else bytes(xb_completo)
+    def _fechar():
+        for slug, folder in pastas_abertos.items():
+            try:
+                if xb_completo:
+                    xn = _nome_excel_pacote_contab_dentro_zip(slug)
+                    _excel_fonte_gravar(xb_completo, folder / xn)
+            except OSError:
+                pass
+
+        excel_solta_path = None
+        if xb_completo:
+            try:
+                out_dir.mkdir(parents=True, exist_ok=True)
+                stem_safe = _v2_sanitize_nome_export(stem_org, max_len=80) or "pacote_apuracao"
+                nome_xlsx = _v2_sanitize_nome_export(
+                    f"{stem_safe}_{_PACOTE_CONTAB_NOME_EXCEL_RAIZ}", max_len=200
+                ) or _PACOTE_CONTAB_NOME_EXCEL_RAIZ
+                if not str(nome_xlsx).lower().endswith(".xlsx"):
+                    nome_xlsx = f"{nome_xlsx}.xlsx"
+                p_x = out_dir / nome_xlsx
+                _excel_fonte_gravar(xb_completo, p_x)
+                excel_solta_path = str(p_x.resolve())
+            except OSError:
+                excel_solta_path = None
+
+        aviso = None
+        if cont["xml_matched"] == 0:
+            aviso = (
+                "Nenhum XML em disco correspondeu às chaves. "
+                "Causas frequentes: pasta do garimpo apagada, ou chaves na tabela que não batem com os ficheiros."
             )
-            with open(p_x, "wb") as xf:
-                xf.write(_raw)
-            excel_solta_path = str(p_x.resolve())
-        except OSError:
-            excel_solta_path = None
+        _paths_list = sorted(paths_ordered.values(), key=lambda p: os.path.basename(p).lower())
+        return _paths_list, [], cont["xml_matched"], aviso, excel_solta_path, indice_td
 
-    aviso = None
-    if xml_matched == 0:
-        aviso = (
-            "Nenhum XML em disco correspondeu às chaves. "
-            "Causas frequentes: pasta do garimpo apagada, ou chaves na tabela que não batem com os ficheiros."
-        )
-    _paths_list = sorted(paths_ordered.values(), key=lambda p: os.path.basename(p).lower())
-    return _paths_list, [], xml_matched, aviso, excel_solta_path, indice_td
+    return {
+        "filtro": lambda r, _p: _chave_para_conjunto_export(r.get("Chave")) in filtro_chaves,
+        "gravar": _gravar,
+        "fechar": _fechar,
+    }
+
+
+def _v2_export_pacote_contab_em_pasta(
+    out_dir: Path,
+    stem_org: str,
+    filtro_chaves: set,
+    cnpj_limpo: str,
+    xb_completo,
+    excel_fn_completo: str,
+    df_ref: pd.DataFrame,
+):
+    """
+    Igual a _v2_export_pacote_contab_por_dimensoes, mas grava em disco pastas com o mesmo conteúdo
+    que cada .zip descompactado (Excel + XML). **Recursivo:** `XML/Lote_NNN/…`; **Domínio:** XML soltos na pasta do grupo.
+    O nome de cada pasta é `<nome_base>__<grupo>` (sem sufixo `_notas_…`, ao contrário do .zip exportado).
+    Devolve (paths pastas, [], matched, aviso, caminho_excel_solta|None, indice_td_paths).
+    indice_td_paths: td_serial -> {"path": rel, "slug": str}.
+    """
+    del excel_fn_completo  # paridade com a função ZIP; nome solto usa _PACOTE_CONTAB_NOME_EXCEL_RAIZ
+    destino = _pacote_contab_destino_pasta(out_dir, stem_org, filtro_chaves, xb_completo, df_ref)
+    _export_lote_passagem_unica(cnpj_limpo, [destino])
+    return destino["fechar"]()
 
 
 def _combo_nome_pacote_contab(
@@ -2173,56 +2745,81 @@ def _espelho_proximo_destino_lote(combo_path: Path) -> tuple[str, Path]:
     return f"{PACOTE_CONTAB_PASTA_MAE_XML}/Lote_{n:03d}", dest
 
 
-def _espelho_manifest_td_meta(cnpj_limpo: str, filtro_chaves: set, df_ref: pd.DataFrame):
-    """Passagem só de metadados: td_serial -> {slug, name, res}."""
+def _espelho_manifest_td_meta(
+    cnpj_limpo: str, filtro_chaves: set, df_ref: pd.DataFrame, reter_local=None
+):
+    """
+    Passagem só de metadados: td_serial -> {slug, name, res}.
+    Com o índice do lote válido não lê nenhum XML (usa o resumo guardado na 1.ª leitura).
+    Sem índice, `reter_local(td_serial)` verdadeiro guarda também onde está a 1.ª ocorrência — a mesma que a
+    passagem pelo lote do destino delta gravaria — em meta["local"], no formato das entradas do índice do
+    lote (fonte, membros, offset…; sem bytes), para `_garimpo_iter_bytes_por_indice` a ir buscar depois.
+    """
     mapa_slug = _montar_mapa_chave_slug_contab(df_ref, filtro_chaves)
     out = {}
+
+    def _meta(name, res, is_p, ck):
+        slug = mapa_slug.get(ck) or _pacote_contab_slug_emitidas_com_mes(
+            is_p,
+            str(res.get("Status") or "NORMAIS"),
+            res.get("Série", "0"),
+            res.get("Tipo", "Outros"),
+            res.get("Ano"),
+            res.get("Mes"),
+            res.get("Operacao"),
+        )
+        return {"slug": slug, "name": name, "res": res}
+
+    entradas = _garimpo_indice_lote_valido(cnpj_limpo)
+    if entradas is not None:
+        for tkey, ent in entradas.items():
+            res = ent["res"]
+            ck = _chave_para_conjunto_export(res.get("Chave"))
+            if not ck or ck not in filtro_chaves:
+                continue
+            name, res, is_p = ent.get("ultimo") or (ent["name"], res, ent["is_p"])
+            out[tkey] = _meta(name, res, is_p, ck)
+        return out
+    retidos = {}
     for f_name in _lista_nomes_fontes_xml_garimpo():
         with _abrir_fonte_xml_garimpo_stream(f_name) as ft:
-            for name, xml_data in extrair_recursivo(ft, f_name):
+            for name, xml_data, membros, zinfo in _extrair_recursivo_com_local(ft, f_name):
                 res, is_p = identify_xml_info(xml_data, cnpj_limpo, name)
                 ck = _chave_para_conjunto_export(res["Chave"]) if res else None
-                del xml_data
                 if not res or not ck or ck not in filtro_chaves:
+                    del xml_data
                     continue
                 td = _tupla_dedupe_export_xml(res, ck)
                 if td is None:
+                    del xml_data
                     continue
                 tkey = _td_chave_serial(td)
-                slug = mapa_slug.get(ck) or _pacote_contab_slug_emitidas_com_mes(
-                    is_p,
-                    str(res.get("Status") or "NORMAIS"),
-                    res.get("Série", "0"),
-                    res.get("Tipo", "Outros"),
-                    res.get("Ano"),
-                    res.get("Mes"),
-                    res.get("Operacao"),
-                )
-                out[tkey] = {"slug": slug, "name": name, "res": res}
+                del xml_data
+                if reter_local is not None and tkey not in retidos and reter_local(tkey):
+                    retidos[tkey] = {
+                        "td": tkey,
+                        "fonte": f_name,
+                        "membros": tuple(membros),
+                        "offset": int(zinfo.header_offset) if zinfo is not None else 0,
+                        "tamanho": int(zinfo.compress_size) if zinfo is not None else 0,
+                        "crc": int(zinfo.CRC) if zinfo is not None else 0,
+                        "tamanho_xml": int(zinfo.file_size) if zinfo is not None else 0,
+                        "name": name,
+                        "res": res,
+                    }
+                out[tkey] = _meta(name, res, is_p, ck)
+    for tkey, local in retidos.items():
+        out[tkey]["local"] = local
     return out
 
 
-def _espelho_ler_bytes_para_td_serial(
-    cnpj_limpo: str, filtro_chaves: set, td_serial: str
-):
-    """2.ª passagem: lê bytes do lote para um único td (dedupe)."""
-    for f_name in _lista_nomes_fontes_xml_garimpo():
-        with _abrir_fonte_xml_garimpo_stream(f_name) as ft:
-            for name, xml_data in extrair_recursivo(ft, f_name):
-                res, _ = identify_xml_info(xml_data, cnpj_limpo, name)
-                ck = _chave_para_conjunto_export(res["Chave"]) if res else None
-                if not res or not ck or ck not in filtro_chaves:
-                    del xml_data
-                    continue
-                td = _tupla_dedupe_export_xml(res, ck)
-                if td is None:
-                    del xml_data
-                    continue
-                if _td_chave_serial(td) != td_serial:
-                    del xml_data
-                    continue
-                return xml_data, res, name
-    return None, None, None
+def _espelho_td_serial_de_res(res, filtro_chaves: set):
+    """td_serial de um resumo (`_td_chave_serial`) ou None se a chave não entra no pacote."""
+    ck = _chave_para_conjunto_export(res.get("Chave")) if res else None
+    if not ck or ck not in filtro_chaves:
+        return None
+    td = _tupla_dedupe_export_xml(res, ck)
+    return _td_chave_serial(td) if td is not None else None
 
 
 def _espelho_regravar_excels_pacote_em_pasta(
@@ -2256,12 +2853,7 @@ def _espelho_regravar_excels_pacote_em_pasta(
             continue
         try:
             xn = _nome_excel_pacote_contab_dentro_zip(slug)
-            _raw = (
-                xb_completo
-                if isinstance(xb_completo, (bytes, bytearray))
-                else bytes(xb_completo)
-            )
-            (folder / xn).write_bytes(_raw)
+            _excel_fonte_gravar(xb_completo, folder / xn)
         except OSError:
             pass
     try:
@@ -2272,32 +2864,25 @@ def _espelho_regravar_excels_pacote_em_pasta(
         if not str(nome_xlsx).lower().endswith(".xlsx"):
             nome_xlsx = f"{nome_xlsx}.xlsx"
         p_x = out_dir / nome_xlsx
-        _raw = (
-            xb_completo
-            if isinstance(xb_completo, (bytes, bytearray))
-            else bytes(xb_completo)
-        )
-        with open(p_x, "wb") as xf:
-            xf.write(_raw)
+        _excel_fonte_gravar(xb_completo, p_x)
     except OSError:
         pass
 
 
-def _v2_export_pacote_contab_em_pasta_delta(
+def _pacote_contab_destino_pasta_delta(
     out_dir: Path,
     stem_org: str,
     filtro_chaves: set,
     cnpj_limpo: str,
     xb_completo,
-    excel_fn_completo: str,
     df_ref: pd.DataFrame,
     prev_index: dict,
 ):
     """
-    Atualiza só remoções, inclusões e mudanças de grupo (slug) face ao índice anterior.
-    Devolve o mesmo 6-tuple que _v2_export_pacote_contab_em_pasta ou None se deve usar exportação completa.
+    Destino delta do espelho para `_export_lote_passagem_unica` (ver `_v2_export_pacote_contab_em_pasta_delta`).
+    As remoções e os XML localizados pelo manifesto (lidos um a um, por offset) gravam-se logo; a passagem pelo
+    lote só entrega os td que faltam (1.ª ocorrência de cada). None se deve usar a exportação completa.
     """
-    del excel_fn_completo
     if (
         not prev_index
         or not out_dir.is_dir()
@@ -2306,7 +2891,9 @@ def _v2_export_pacote_contab_em_pasta_delta(
     ):
         return None
     try:
-        manifest = _espelho_manifest_td_meta(cnpj_limpo, filtro_chaves, df_ref)
+        manifest = _espelho_manifest_td_meta(
+            cnpj_limpo, filtro_chaves, df_ref, reter_local=lambda k: k not in prev_index
+        )
     except Exception:
         return None
     novo_keys = set(manifest.keys())
@@ -2333,10 +2920,11 @@ def _v2_export_pacote_contab_em_pasta_delta(
             pass
     indice_td = {k: dict(v) for k, v in prev_index.items() if k in novo_keys and k not in mover}
     _delta_pasta_dominio = _garimpo_extracao_pasta_espelho() == "dominio"
-    for k in adicionar:
+
+    def _gravar(k, data_b, res, name):
         meta = manifest.get(k)
-        if not meta:
-            continue
+        if not meta or not data_b or not res:
+            return
         slug = meta["slug"]
         combo = _combo_nome_pacote_contab(
             stem_org, slug, slug_ranges, incluir_sufixo_notas=False
@@ -2346,9 +2934,6 @@ def _v2_export_pacote_contab_em_pasta_delta(
             folder.mkdir(parents=True, exist_ok=True)
         except OSError:
             pass
-        data_b, res, name = _espelho_ler_bytes_para_td_serial(cnpj_limpo, filtro_chaves, k)
-        if not data_b or not res:
-            continue
         _nm = _nome_arquivo_xml_contabilidade(res, name)
         if _delta_pasta_dominio:
             _inner = _nm
@@ -2366,34 +2951,86 @@ def _v2_export_pacote_contab_em_pasta_delta(
             }
         except (OSError, ValueError):
             pass
-    _espelho_regravar_excels_pacote_em_pasta(
-        out_dir, stem_org, df_ref, filtro_chaves, xb_completo
-    )
-    xml_matched = len(manifest)
-    aviso = None
-    if xml_matched == 0:
-        aviso = (
-            "Nenhum XML em disco correspondeu às chaves. "
-            "Causas frequentes: pasta do garimpo apagada, ou chaves na tabela que não batem com os ficheiros."
+
+    # XML localizados pela passagem do manifesto (sem índice): lidos agora um a um, só os que entram, sem os
+    # guardar todos em memória; os restantes (ou ilegíveis) chegam pela passagem única pelo lote, partilhada
+    # com os outros destinos (ex.: ZIPs do pacote).
+    por_ler = {k for k in adicionar if k in manifest}
+    locais = [manifest[k].pop("local") for k in manifest if k in por_ler and "local" in manifest[k]]
+    for meta in manifest.values():
+        meta.pop("local", None)
+    for ent, data_b in _garimpo_iter_bytes_por_indice(locais):
+        _gravar(ent["td"], data_b, ent["res"], ent["name"])
+        por_ler.discard(ent["td"])
+    del locais
+
+    def _gravar_do_lote(name, xml_data, res, _is_p):
+        k = _espelho_td_serial_de_res(res, filtro_chaves)
+        if k not in por_ler:
+            return
+        por_ler.discard(k)
+        _gravar(k, xml_data, res, name)
+
+    def _fechar():
+        _espelho_regravar_excels_pacote_em_pasta(
+            out_dir, stem_org, df_ref, filtro_chaves, xb_completo
+        )
+        xml_matched = len(manifest)
+        aviso = None
+        if xml_matched == 0:
+            aviso = (
+                "Nenhum XML em disco correspondeu às chaves. "
+                "Causas frequentes: pasta do garimpo apagada, ou chaves na tabela que não batem com os ficheiros."
+            )
+        paths_ordered = sorted(
+            [str(p.resolve()) for p in out_dir.iterdir() if p.is_dir()],
+            key=lambda x: os.path.basename(x).lower(),
         )
-    paths_ordered = sorted(
-        [str(p.resolve()) for p in out_dir.iterdir() if p.is_dir()],
-        key=lambda x: os.path.basename(x).lower(),
+        excel_solta = None
+        try:
+            stem_safe = _v2_sanitize_nome_export(stem_org, max_len=80) or "pacote_apuracao"
+            nome_xlsx = _v2_sanitize_nome_export(
+                f"{stem_safe}_{_PACOTE_CONTAB_NOME_EXCEL_RAIZ}", max_len=200
+            ) or _PACOTE_CONTAB_NOME_EXCEL_RAIZ
+            if not str(nome_xlsx).lower().endswith(".xlsx"):
+                nome_xlsx = f"{nome_xlsx}.xlsx"
+            p_x = out_dir / nome_xlsx
+            if p_x.is_file():
+                excel_solta = str(p_x.resolve())
+        except OSError:
+            pass
+        return paths_ordered, [], xml_matched, aviso, excel_solta, indice_td
+
+    return {
+        "filtro": lambda r, _p: _espelho_td_serial_de_res(r, filtro_chaves) in por_ler,
+        "gravar": _gravar_do_lote,
+        "concluido": lambda: not por_ler,
+        "fechar": _fechar,
+    }
+
+
+def _v2_export_pacote_contab_em_pasta_delta(
+    out_dir: Path,
+    stem_org: str,
+    filtro_chaves: set,
+    cnpj_limpo: str,
+    xb_completo,
+    excel_fn_completo: str,
+    df_ref: pd.DataFrame,
+    prev_index: dict,
+):
+    """
+    Atualiza só remoções, inclusões e mudanças de grupo (slug) face ao índice anterior.
+    Devolve o mesmo 6-tuple que _v2_export_pacote_contab_em_pasta ou None se deve usar exportação completa.
+    """
+    del excel_fn_completo
+    destino = _pacote_contab_destino_pasta_delta(
+        out_dir, stem_org, filtro_chaves, cnpj_limpo, xb_completo, df_ref, prev_index
     )
-    excel_solta = None
-    try:
-        stem_safe = _v2_sanitize_nome_export(stem_org, max_len=80) or "pacote_apuracao"
-        nome_xlsx = _v2_sanitize_nome_export(
-            f"{stem_safe}_{_PACOTE_CONTAB_NOME_EXCEL_RAIZ}", max_len=200
-        ) or _PACOTE_CONTAB_NOME_EXCEL_RAIZ
-        if not str(nome_xlsx).lower().endswith(".xlsx"):
-            nome_xlsx = f"{nome_xlsx}.xlsx"
-        p_x = out_dir / nome_xlsx
-        if p_x.is_file():
-            excel_solta = str(p_x.resolve())
-    except OSError:
-        pass
-    return paths_ordered, [], xml_matched, aviso, excel_solta, indice_td
+    if destino is None:
+        return None
+    _export_lote_passagem_unica(cnpj_limpo, [destino])
+    return destino["fechar"]()
 
 
 def _tupla_dedupe_export_xml(res: dict | None, ck) -> tuple | None:
@@ -2526,56 +3163,200 @@ def _chave44_do_nome_arquivo(nome_puro: str):
     return cand if cand.isdigit() and len(cand) == 44 else None
 
 
-def _xml_tp_evento_codigo(tag_l: str, codigo: str) -> bool:
-    """
-    Detecta tpEvento com o código SEFAZ (ex.: 110111 cancelamento, 110110 CCe).
-    `tag_l` está em minúsculas (tpevento, não tpEvento). Evita falso positivo quando
-    o mesmo dígito aparece na chave de 44 posições ou noutros campos numéricos.
-    Aceita XML formatado (espaços/newlines entre tags e o código).
-    """
-    if len(codigo) != 6 or not codigo.isdigit():
-        return False
-    return bool(re.search(rf"[\w:]*tpevento>\s*{codigo}\s*</", tag_l))
+_IDENTIFY_RE_CONTEXTO_EVENTO = re.compile(
+    r"proceventonfe|proceventocte|proceventomdfe|retenvevento|infevento|"
+    r"descevento>\s*cancelamento"
+)
 
 
-def _xml_cancelamento_por_evento_ou_retorno(tag_l: str) -> bool:
-    """Cancelamento homologado: evento 110111 ou retorno de evento com cStat 101 em contexto de evento."""
-    if _xml_tp_evento_codigo(tag_l, "110111"):
+def _xml_cancelamento_por_evento_ou_retorno(tag_l: str, folhas: dict | None = None) -> bool:
+    """
+    Cancelamento homologado: evento 110111 ou retorno de evento com cStat 101 em contexto de evento.
+    `folhas` (de `_identify_varrer_folhas`) evita voltar a percorrer o XML.
+    """
+    if folhas is None:
+        folhas = _identify_varrer_folhas(tag_l)
+    if "110111" in folhas["tpevento"]:
         return True
-    if not re.search(r"<cstat>\s*101\s*</cstat>", tag_l):
+    if not folhas["cstat101"]:
         return False
     # cStat 101 isolado pode aparecer noutros retornos; restringe a XML de evento/cancelamento.
-    return bool(
-        re.search(
-            r"proceventonfe|proceventocte|proceventomdfe|retenvevento|infevento|"
-            r"descevento>\s*cancelamento",
-            tag_l,
-        )
-    )
+    return bool(_IDENTIFY_RE_CONTEXTO_EVENTO.search(tag_l))
+
+
+# Tags-folha do identify: cada nome é localizado com `str.find` (varrimento em C, sem retrocesso) e validado
+# com o padrão de sempre ancorado logo a seguir ao «>» — medido mais rápido do que um finditer com alternância.
+_IDENTIFY_RE_TPNF_VAL = re.compile(r"([01])</")
+_IDENTIFY_RE_DATA_VAL = re.compile(r"(\d{4})-(\d{2})-(\d{2})")
+_IDENTIFY_RE_CHAVE_VAL = re.compile(r"(\d{44})</")
+_IDENTIFY_RE_TPEVENTO_VAL = re.compile(r"\s*(\d{6})\s*</")
+_IDENTIFY_RE_CSTAT_VAL = re.compile(r"(\s*)(\d+)(\s*)</cstat>")
+_IDENTIFY_RE_VALOR_VAL = re.compile(r"([\d.]+)</")
+_IDENTIFY_FOLHAS_DATA = ("dhemi", "demi", "dhregevento", "dhrecbto")
+_IDENTIFY_FOLHAS_CHAVE = ("chnfe", "chcte", "chmdfe")
+_IDENTIFY_FOLHAS_VALOR = ("vnf", "vtprest", "vreceb")
+
+
+def _identify_tag_com_prefixo_ns(tag_l: str, s: int) -> bool:
+    """True se o nome que começa em `s` vem de `<prefixo:` (prefixo = um ou mais caracteres \\w)."""
+    j = s - 1
+    if j < 1 or tag_l[j] != ":":
+        return False
+    j -= 1
+    k = j
+    while k >= 0 and (tag_l[k].isalnum() or tag_l[k] == "_"):
+        k -= 1
+    return k < j and k >= 0 and tag_l[k] == "<"
 
 
-def _emit_cnpj_bloco_principal_fiscal(tag_l: str, tipo: str) -> str:
+def _identify_primeira_folha(tag_l: str, nomes, val_re, tag_ok):
     """
-    CNPJ do emitente **dentro** do infNFe / infCte / infMDFe do documento.
-    O regex global `<emit>…<cnpj>` apanha por vezes o primeiro `<emit>` de **evento**, **retorno**
+    (1.ª ocorrência válida de qualquer dos `nomes`, 1.ª válida em que `tag_ok(pos)` é verdadeiro) — cada uma
+    como match de `val_re` ou None. Equivale a `(?:n1|n2…)>val` e à variante com a tag «limpa».
+    """
+    best_any = best_tag = None
+    for nm in nomes:
+        k = nm + ">"
+        i = tag_l.find(k)
+        while i >= 0:
+            if best_tag is not None and i > best_tag.start():
+                break
+            v = val_re.match(tag_l, i + len(k))
+            if v:
+                if best_any is None or v.start() < best_any.start():
+                    best_any = v
+                if tag_ok(i):
+                    if best_tag is None or v.start() < best_tag.start():
+                        best_tag = v
+                    break
+            i = tag_l.find(k, i + 1)
+    return best_any, best_tag
+
+
+def _identify_varrer_folhas(tag_l: str) -> dict:
+    """
+    Campos-folha do identify (tpNF, data, chave, tpEvento, cStat, valor) numa só chamada, com a mesma regra de
+    antes: 1.ª ocorrência válida e, à parte, a 1.ª com a tag «limpa» (`<nome>` / `<ns:nome>`), que tem prioridade.
+    """
+    f = {
+        "tpnf": None,
+        "data": None,
+        "data_tag": None,
+        "chave": None,
+        "chave_tag": None,
+        "tpevento": set(),
+        "cstat101": False,
+        "cstat110": False,
+        "cstat_rej": False,
+        "valor": None,
+        "valor_tag": None,
+    }
+    i = tag_l.find("tpnf>")
+    while i >= 0:
+        v = _IDENTIFY_RE_TPNF_VAL.match(tag_l, i + 5)
+        if v:
+            f["tpnf"] = v.group(1)
+            break
+        i = tag_l.find("tpnf>", i + 1)
+
+    def _lt(pos):
+        return pos > 0 and tag_l[pos - 1] == "<"
+
+    d_any, d_tag = _identify_primeira_folha(tag_l, _IDENTIFY_FOLHAS_DATA, _IDENTIFY_RE_DATA_VAL, _lt)
+    f["data"] = d_any.groups() if d_any else None
+    f["data_tag"] = d_tag.groups() if d_tag else None
+    c_any, c_tag = _identify_primeira_folha(tag_l, _IDENTIFY_FOLHAS_CHAVE, _IDENTIFY_RE_CHAVE_VAL, _lt)
+    f["chave"] = c_any.group(1) if c_any else None
+    f["chave_tag"] = c_tag.group(1) if c_tag else None
+    v_any, v_tag = _identify_primeira_folha(
+        tag_l,
+        _IDENTIFY_FOLHAS_VALOR,
+        _IDENTIFY_RE_VALOR_VAL,
+        lambda pos: _lt(pos) or _identify_tag_com_prefixo_ns(tag_l, pos),
+    )
+    f["valor"] = v_any.group(1) if v_any else None
+    f["valor_tag"] = v_tag.group(1) if v_tag else None
+
+    # tpEvento com o código SEFAZ (110111 cancelamento, 110110 CCe) só dentro da tag — o mesmo dígito na chave
+    # de 44 posições não conta; aceita XML formatado (espaços/newlines à volta do código).
+    i = tag_l.find("tpevento>")
+    while i >= 0:
+        v = _IDENTIFY_RE_TPEVENTO_VAL.match(tag_l, i + 9)
+        if v:
+            f["tpevento"].add(v.group(1))
+        i = tag_l.find("tpevento>", i + 1)
+    i = tag_l.find("<cstat>")
+    while i >= 0:
+        v = _IDENTIFY_RE_CSTAT_VAL.match(tag_l, i + 7)
+        if v:
+            cod = v.group(2)
+            if cod == "101":
+                f["cstat101"] = True
+            if not v.group(1) and not v.group(3):
+                if cod == "110":
+                    f["cstat110"] = True
+                elif len(cod) == 3 and ("301" <= cod <= "309" or "310" <= cod <= "349"):
+                    f["cstat_rej"] = True
+        i = tag_l.find("<cstat>", i + 1)
+    return f
+
+
+# Blocos `<emit>…` / `<dest>…`: o alvo tem de começar até 12 000 caracteres depois da tag de abertura.
+_IDENTIFY_JANELA_BLOCO = 12000
+_IDENTIFY_RE_ABRE_EMIT = re.compile(r"(?:<\w+:emit\b|<emit\b)[^>]*>")
+_IDENTIFY_RE_ABRE_DEST = re.compile(r"(?:<\w+:dest\b|<dest\b)[^>]*>")
+_IDENTIFY_RE_CNPJ_11_14 = re.compile(r"(?:<\w+:cnpj>|<cnpj>)(\d{11,14})</(?:\w+:cnpj|cnpj)>")
+_IDENTIFY_RE_XNOME = re.compile(r"(?:<\w+:xnome>|<xnome>)(.*?)</(?:\w+:xnome|xnome)>", re.S)
+_IDENTIFY_RE_DOC_DEST = re.compile(
+    r"(?:<\w+:cnpj>|<cnpj>|<\w+:cpf>|<cpf>)(.*?)</(?:\w+:cnpj|cnpj|\w+:cpf|cpf)>", re.S
+)
+_IDENTIFY_RE_UF = re.compile(r"(?:<\w+:uf>|<uf>)([a-z]{2})</(?:\w+:uf|uf)>", re.S)
+_IDENTIFY_RE_ABRE_INFINUT = re.compile(r"<[^>]*infinut[^>]*>", re.I)
+_IDENTIFY_RE_ABRE_INUTNFE = re.compile(r"<inutnfe[^>]*>", re.I)
+_IDENTIFY_RE_CNPJ_INUT = re.compile(r"<cnpj>(\d{11,14})</cnpj>", re.I)
+_IDENTIFY_RE_ABRE_INF_DOC = {
+    "CT-e": re.compile(r"<(?:\w+:)?infcte\b[^>]*>", re.I),
+    "CT-e OS": re.compile(r"<(?:\w+:)?infcte\b[^>]*>", re.I),
+    "MDF-e": re.compile(r"<(?:\w+:)?infmdfe\b[^>]*>", re.I),
+    "NF-e": re.compile(r"<(?:\w+:)?infnfe\b[^>]*>", re.I),
+    "NFC-e": re.compile(r"<(?:\w+:)?infnfe\b[^>]*>", re.I),
+}
+
+
+def _identify_primeiro_no_bloco(texto: str, abre_re, alvo_re, janela: int = _IDENTIFY_JANELA_BLOCO):
+    """
+    Mesmo match que `abre[\\s\\S]{0,janela}?alvo` (1.ª abertura cujo alvo começa até `janela` caracteres
+    depois dela), mas com duas pesquisas lineares em vez do quantificador preguiçoso. Devolve o match do alvo.
+    """
+    pos = 0
+    alvo = None
+    while True:
+        m = abre_re.search(texto, pos)
+        if m is None:
+            return None
+        if alvo is None or alvo.start() < m.end():
+            alvo = alvo_re.search(texto, m.end())
+            if alvo is None:
+                return None
+        if alvo.start() - m.end() <= janela:
+            return alvo
+        pos = m.start() + 1
+
+
+def _emit_cnpj_bloco_principal_fiscal(tag_l: str, tipo: str) -> str:
+    """
+    CNPJ do emitente **dentro** do infNFe / infCte / infMDFe do documento.
+    O regex global `<emit>…<cnpj>` apanha por vezes o primeiro `<emit>` de **evento**, **retorno**
     ou outro anexo antes do documento — CT-e/NF-e de terceiros acabavam como «emissão própria».
     """
-    if tipo in ("CT-e", "CT-e OS"):
-        open_pat = r"<(?:\w+:)?infcte\b[^>]*>"
-    elif tipo == "MDF-e":
-        open_pat = r"<(?:\w+:)?infmdfe\b[^>]*>"
-    elif tipo in ("NF-e", "NFC-e"):
-        open_pat = r"<(?:\w+:)?infnfe\b[^>]*>"
-    else:
+    open_re = _IDENTIFY_RE_ABRE_INF_DOC.get(tipo)
+    if open_re is None:
         return ""
-    m = re.search(open_pat, tag_l, re.I)
+    m = open_re.search(tag_l)
     if not m:
         return ""
     chunk = tag_l[m.start() : m.start() + 600000]
-    em = re.search(
-        r"(?:<\w+:emit\b|<emit\b)[^>]*>[\s\S]{0,12000}?(?:<\w+:cnpj>|<cnpj>)(\d{11,14})</(?:\w+:cnpj|cnpj)>",
-        chunk,
-    )
+    em = _identify_primeiro_no_bloco(chunk, _IDENTIFY_RE_ABRE_EMIT, _IDENTIFY_RE_CNPJ_11_14)
     return em.group(1) if em else ""
 
 
@@ -2628,60 +3409,33 @@ def identify_xml_info(content_bytes, client_cnpj, file_name):
         )
         if not _parece_nfe_cte:
             return None, False
+        folhas = _identify_varrer_folhas(tag_l)
 
         # Identificação de tpNF (0=Entrada, 1=Saída) — com ou sem prefixo no nome da tag
-        tp_nf_match = re.search(r"tpnf>([01])</", tag_l)
-        if tp_nf_match:
-            if tp_nf_match.group(1) == "0":
+        if folhas["tpnf"] is not None:
+            if folhas["tpnf"] == "0":
                 resumo["Operacao"] = "ENTRADA"
             else:
                 resumo["Operacao"] = "SAIDA"
 
         # Extração emit/dest — tags podem ser <emit> ou <nfe:emit> (já em minúsculas).
-        _m_em_cnpj = re.search(
-            r"(?:<\w+:emit\b|<emit\b)[^>]*>[\s\S]{0,12000}?(?:<\w+:cnpj>|<cnpj>)(\d{11,14})</(?:\w+:cnpj|cnpj)>",
-            tag_l,
-        )
+        _m_em_cnpj = _identify_primeiro_no_bloco(tag_l, _IDENTIFY_RE_ABRE_EMIT, _IDENTIFY_RE_CNPJ_11_14)
         resumo["CNPJ_Emit"] = _m_em_cnpj.group(1) if _m_em_cnpj else ""
-        _m_em_nom = re.search(
-            r"(?:<\w+:emit\b|<emit\b)[^>]*>[\s\S]{0,12000}?(?:<\w+:xnome>|<xnome>)(.*?)</(?:\w+:xnome|xnome)>",
-            tag_l,
-            re.S,
-        )
+        _m_em_nom = _identify_primeiro_no_bloco(tag_l, _IDENTIFY_RE_ABRE_EMIT, _IDENTIFY_RE_XNOME)
         resumo["Nome_Emit"] = _m_em_nom.group(1).strip().upper() if _m_em_nom else ""
-        _m_dd = re.search(
-            r"(?:<\w+:dest\b|<dest\b)[^>]*>[\s\S]{0,12000}?(?:<\w+:cnpj>|<cnpj>|<\w+:cpf>|<cpf>)(.*?)</(?:\w+:cnpj|cnpj|\w+:cpf|cpf)>",
-            tag_l,
-            re.S,
-        )
+        _m_dd = _identify_primeiro_no_bloco(tag_l, _IDENTIFY_RE_ABRE_DEST, _IDENTIFY_RE_DOC_DEST)
         resumo["Doc_Dest"] = _m_dd.group(1).strip() if _m_dd else ""
-        _m_dn = re.search(
-            r"(?:<\w+:dest\b|<dest\b)[^>]*>[\s\S]{0,12000}?(?:<\w+:xnome>|<xnome>)(.*?)</(?:\w+:xnome|xnome)>",
-            tag_l,
-            re.S,
-        )
+        _m_dn = _identify_primeiro_no_bloco(tag_l, _IDENTIFY_RE_ABRE_DEST, _IDENTIFY_RE_XNOME)
         resumo["Nome_Dest"] = _m_dn.group(1).strip().upper() if _m_dn else ""
-        _uf_m = re.search(
-            r"(?:<\w+:dest\b|<dest\b)[^>]*>[\s\S]{0,12000}?(?:<\w+:uf>|<uf>)([a-z]{2})</(?:\w+:uf|uf)>",
-            tag_l,
-            re.S,
-        )
+        _uf_m = _identify_primeiro_no_bloco(tag_l, _IDENTIFY_RE_ABRE_DEST, _IDENTIFY_RE_UF)
         resumo["UF_Dest"] = _uf_m.group(1).upper() if _uf_m else ""
 
         # Data de Emissão Genérica (com ou sem prefixo no nome da tag)
-        data_match = re.search(
-            r"<(?:dhemi|demi|dhregevento|dhrecbto)>(\d{4})-(\d{2})-(\d{2})",
-            tag_l,
-        )
-        if not data_match:
-            data_match = re.search(
-                r"(?:dhemi|demi|dhregevento|dhrecbto)>(\d{4})-(\d{2})-(\d{2})",
-                tag_l,
-            )
+        data_match = folhas["data_tag"] or folhas["data"]
         if data_match: 
-            resumo["Data_Emissao"] = f"{data_match.group(1)}-{data_match.group(2)}-{data_match.group(3)}"
-            resumo["Ano"] = data_match.group(1)
-            resumo["Mes"] = data_match.group(2)
+            resumo["Data_Emissao"] = f"{data_match[0]}-{data_match[1]}-{data_match[2]}"
+            resumo["Ano"] = data_match[0]
+            resumo["Mes"] = data_match[1]
 
         # 1. IDENTIFICAÃ‡ÃƒO DE INUTILIZADAS
         if (
@@ -2717,20 +3471,15 @@ def identify_xml_info(content_bytes, client_cnpj, file_name):
             # Inutilização: o emitente está em infInut / inutNFe, não em <emit> — sem isto CNPJ_Emit fica vazio
             # e is_p fica sempre falso (pacote/ZIP aparece como «terceiros» mesmo sendo o mesmo CNPJ).
             if not resumo["CNPJ_Emit"]:
-                for _pat in (
-                    r"<[^>]*infinut[^>]*>[\s\S]{0,12000}?<cnpj>(\d{11,14})</cnpj>",
-                    r"<inutnfe[^>]*>[\s\S]{0,12000}?<cnpj>(\d{11,14})</cnpj>",
-                ):
-                    _mc = re.search(_pat, tag_l, re.I)
+                for _abre in (_IDENTIFY_RE_ABRE_INFINUT, _IDENTIFY_RE_ABRE_INUTNFE):
+                    _mc = _identify_primeiro_no_bloco(tag_l, _abre, _IDENTIFY_RE_CNPJ_INUT)
                     if _mc:
                         resumo["CNPJ_Emit"] = _mc.group(1)
                         break
 
         else:
-            match_ch = re.search(r'<(?:chnfe|chcte|chmdfe)>(\d{44})</', tag_l)
-            if not match_ch:
-                # <nfe:chNFe>44</nfe:chNFe> â†’ minúsculas: chnfe>44</
-                match_ch = re.search(r"ch(?:nfe|cte|mdfe)>(\d{44})</", tag_l)
+            # <nfe:chNFe>44</nfe:chNFe> â†’ minúsculas: chnfe>44</ (só se não houver <chnfe> sem prefixo)
+            match_ch = folhas["chave_tag"] or folhas["chave"]
             if not match_ch:
                 match_ch = re.search(r'id=["\'](?:nfe|cte|mdfe)?(\d{44})["\']', tag_l)
                 if match_ch:
@@ -2738,7 +3487,7 @@ def identify_xml_info(content_bytes, client_cnpj, file_name):
                 else:
                     resumo["Chave"] = ""
             else:
-                resumo["Chave"] = match_ch.group(1)
+                resumo["Chave"] = match_ch
 
             if (not resumo["Chave"] or len(resumo["Chave"]) != 44) and nome_puro:
                 _kfn = _chave44_do_nome_arquivo(nome_puro)
@@ -2785,15 +3534,13 @@ def identify_xml_info(content_bytes, client_cnpj, file_name):
                     tipo = "NFS-e"
             
             status = "NORMAIS"
-            if _xml_cancelamento_por_evento_ou_retorno(tag_l):
+            if _xml_cancelamento_por_evento_ou_retorno(tag_l, folhas):
                 status = "CANCELADOS"
-            elif _xml_tp_evento_codigo(tag_l, "110110"):
+            elif "110110" in folhas["tpevento"]:
                 status = "CARTA_CORRECAO"
-            elif re.search(r"<cstat>110</cstat>", tag_l) or "deneg" in tag_l:
+            elif folhas["cstat110"] or "deneg" in tag_l:
                 status = "DENEGADOS"
-            elif re.search(r"<cstat>30[1-9]</cstat>", tag_l) or re.search(
-                r"<cstat>3[1-4]\d</cstat>", tag_l
-            ):
+            elif folhas["cstat_rej"]:
                 status = "REJEITADOS"
                 
             resumo["Tipo"] = tipo
@@ -2806,14 +3553,9 @@ def identify_xml_info(content_bytes, client_cnpj, file_name):
                 return None, False
 
             if status == "NORMAIS":
-                v_match = re.search(
-                    r"(?:<(?:vnf|vtprest|vreceb)>|<\w+:(?:vnf|vtprest|vreceb)>)([\d.]+)</",
-                    tag_l,
-                )
-                if not v_match:
-                    v_match = re.search(r"(?:vnf|vtprest|vreceb)>([\d.]+)</", tag_l)
+                v_match = folhas["valor_tag"] or folhas["valor"]
                 if v_match:
-                    resumo["Valor"] = float(v_match.group(1))
+                    resumo["Valor"] = float(v_match)
                 else:
                     resumo["Valor"] = 0.0
             
@@ -2826,20 +3568,27 @@ def identify_xml_info(content_bytes, client_cnpj, file_name):
         if resumo["Ano"] == "0000": 
             resumo["Ano"] = "2000"
 
-        _emit_cmp = "".join(c for c in str(resumo["CNPJ_Emit"] or "") if c.isdigit())[:14]
-        is_p = bool(client_cnpj_clean) and len(client_cnpj_clean) == 14 and _emit_cmp == client_cnpj_clean
-        
-        if is_p:
-            resumo["Pasta"] = f"EMITIDOS_CLIENTE/{resumo['Operacao']}/{resumo['Tipo']}/{resumo['Status']}/{resumo['Ano']}/{resumo['Mes']}/Serie_{resumo['Série']}"
-        else:
-            resumo["Pasta"] = f"RECEBIDOS_TERCEIROS/{resumo['Operacao']}/{resumo['Tipo']}/{resumo['Ano']}/{resumo['Mes']}"
-            
-        return resumo, is_p
+        return resumo, _identify_aplicar_cliente(resumo, client_cnpj_clean)
         
     except Exception as e: 
         return None, False
 
 
+def _identify_aplicar_cliente(resumo, client_cnpj_clean: str) -> bool:
+    """
+    Única parte de `identify_xml_info` que depende do CNPJ do cliente: is_p (emitente = cliente) e «Pasta».
+    Também usada ao levantar da cache de identificação um resumo calculado para outro cliente.
+    """
+    _emit_cmp = "".join(c for c in str(resumo["CNPJ_Emit"] or "") if c.isdigit())[:14]
+    is_p = bool(client_cnpj_clean) and len(client_cnpj_clean) == 14 and _emit_cmp == client_cnpj_clean
+
+    if is_p:
+        resumo["Pasta"] = f"EMITIDOS_CLIENTE/{resumo['Operacao']}/{resumo['Tipo']}/{resumo['Status']}/{resumo['Ano']}/{resumo['Mes']}/Serie_{resumo['Série']}"
+    else:
+        resumo["Pasta"] = f"RECEBIDOS_TERCEIROS/{resumo['Operacao']}/{resumo['Tipo']}/{resumo['Ano']}/{resumo['Mes']}"
+    return is_p
+
+
 _TIPOS_RESUMO_POR_SERIE = frozenset({"NF-e", "NFC-e", "NFS-e"})
 
 
@@ -2971,6 +3720,14 @@ def extrair_fonte_xml_garimpo(conteudo_ou_file, nome_arquivo):
     yield from extrair_recursivo(conteudo_ou_file, nome_arquivo)
 
 
+def extrair_fonte_xml_garimpo_com_local(conteudo_ou_file, nome_arquivo, consultar=None):
+    """
+    Como `extrair_fonte_xml_garimpo`, com (nome, bytes, membros, zinfo) para o índice do lote.
+    `consultar`: ver `_extrair_recursivo_com_local` (cache de identificação).
+    """
+    yield from _extrair_recursivo_com_local(conteudo_ou_file, nome_arquivo, consultar=consultar)
+
+
 # --- FUNÃ‡ÃƒO RECURSIVA OTIMIZADA PARA DISCO ---
 def extrair_recursivo(conteudo_ou_file, nome_arquivo):
     """
@@ -2978,6 +3735,20 @@ def extrair_recursivo(conteudo_ou_file, nome_arquivo):
     ZIP dentro de ZIP: lê para memória (BytesIO) em vez de extract para disco — evita falhas no Windows
     (caminho longo, antivírus, pastas aninhadas no nome da entrada).
     """
+    for name, data, _membros, _zinfo in _extrair_recursivo_com_local(conteudo_ou_file, nome_arquivo):
+        yield name, data
+
+
+def _extrair_recursivo_com_local(conteudo_ou_file, nome_arquivo, _membros=(), consultar=None):
+    """
+    Igual a `extrair_recursivo`, mas devolve também onde está cada XML:
+    (nome_base, bytes, membros, zinfo) — `membros` é o caminho de entradas ZIP desde a fonte do lote
+    (ZIPs aninhados incluídos; vazio quando a fonte é o próprio .xml) e `zinfo` o `ZipInfo` da entrada
+    no ZIP que a contém (offset do cabeçalho local, tamanho comprimido, CRC) ou None.
+
+    `consultar([(nome_base, zinfo), …]) -> {(nome_base, CRC, tamanho), …}`: chamado por blocos de entradas .xml
+    de cada ZIP; as entradas devolvidas saem com bytes None (não são lidas — o resultado já está em cache).
+    """
     if not os.path.exists(TEMP_EXTRACT_DIR):
         os.makedirs(TEMP_EXTRACT_DIR)
 
@@ -2994,7 +3765,13 @@ def extrair_recursivo(conteudo_ou_file, nome_arquivo):
                 file_obj = io.BytesIO(conteudo_ou_file)
 
             with zipfile.ZipFile(file_obj) as z:
-                for sub_nome in z.namelist():
+                nomes_zip = z.namelist()
+                saltar = set()
+                for i_nome, sub_nome in enumerate(nomes_zip):
+                    if consultar is not None and i_nome % _GARIM_CACHE_IDENT_BLOCO_CONSULTA == 0:
+                        saltar = _extrair_consultar_bloco(
+                            z, nomes_zip[i_nome : i_nome + _GARIM_CACHE_IDENT_BLOCO_CONSULTA], consultar
+                        )
                     if sub_nome.startswith("__MACOSX") or os.path.basename(sub_nome).startswith("."):
                         continue
                     if sub_nome.endswith("/") or sub_nome.endswith("\\"):
@@ -3009,13 +3786,25 @@ def extrair_recursivo(conteudo_ou_file, nome_arquivo):
                             continue
                         if not _zip_inner:
                             continue
-                        yield from extrair_recursivo(
+                        yield from _extrair_recursivo_com_local(
                             io.BytesIO(_zip_inner),
                             base_sub,
+                            _membros + (sub_nome,),
+                            consultar,
                         )
                     elif sub_nome.lower().endswith(".xml"):
                         try:
-                            yield (base_sub, z.read(sub_nome))
+                            if sub_nome in saltar:
+                                # Só a 1.ª ocorrência de um nome repetido no ZIP sai da cache.
+                                saltar.discard(sub_nome)
+                                yield base_sub, None, _membros + (sub_nome,), z.getinfo(sub_nome)
+                                continue
+                            yield (
+                                base_sub,
+                                z.read(sub_nome),
+                                _membros + (sub_nome,),
+                                z.getinfo(sub_nome),
+                            )
                         except (OSError, KeyError, RuntimeError):
                             continue
         except (zipfile.BadZipFile, OSError, RuntimeError):
@@ -3023,6027 +3812,10554 @@ def extrair_recursivo(conteudo_ou_file, nome_arquivo):
 
     elif nome_arquivo.lower().endswith(".xml"):
         if hasattr(conteudo_ou_file, "read"):
-            yield (os.path.basename(nome_arquivo), conteudo_ou_file.read())
+            yield (os.path.basename(nome_arquivo), conteudo_ou_file.read(), _membros, None)
         else:
-            yield (os.path.basename(nome_arquivo), conteudo_ou_file)
+            yield (os.path.basename(nome_arquivo), conteudo_ou_file, _membros, None)
 
-# --- LIMPEZA DE PASTAS TEMPORÁRIAS ---
-def limpar_arquivos_temp():
-    """
-    Só limpa subpastas dedicadas da app — **nunca** apaga ficheiros na pasta de trabalho (cwd),
-    para não remover ZIP que o utilizador descarregou para a mesma pasta onde corre o Streamlit.
-    """
-    try:
-        if os.path.exists(TEMP_EXTRACT_DIR):
-            shutil.rmtree(TEMP_EXTRACT_DIR, ignore_errors=True)
 
-        if os.path.exists(TEMP_UPLOADS_DIR):
-            shutil.rmtree(TEMP_UPLOADS_DIR, ignore_errors=True)
-        _garimpo_limpar_fontes_xml_memoria_sessao()
+def _extrair_consultar_bloco(z, nomes, consultar) -> set:
+    """Entradas .xml de `nomes` (um bloco do ZIP) cujo resultado `consultar` já tem — nomes completos no ZIP."""
+    pedidos = {}
+    for sub_nome in nomes:
+        if not sub_nome.lower().endswith(".xml") or sub_nome.startswith("__MACOSX"):
+            continue
+        base_sub = os.path.basename(sub_nome)
+        if not base_sub or base_sub.startswith("."):
+            continue
         try:
-            st.session_state.pop(SESSION_KEY_EXTRA_DIGESTS, None)
-        except Exception:
-            pass
+            pedidos[sub_nome] = (base_sub, z.getinfo(sub_nome))
+        except KeyError:
+            continue
+    if not pedidos:
+        return set()
+    try:
+        achados = set(consultar(list(pedidos.values())) or ())
     except Exception:
-        pass
+        return set()
+    return {
+        sub_nome for sub_nome, (base_sub, zi) in pedidos.items() if (base_sub, zi.CRC, zi.file_size) in achados
+    }
 
-# --- DIVISOR DE LOTES HTML (Para deixar botões organizados) ---
-def chunk_list(lst, n):
-    for i in range(0, len(lst), n): 
-        yield lst[i:i + n]
 
+# --- ÍNDICE DO LOTE (chave → onde estão os bytes) ---
+# Construído na 1.ª leitura (grande garimpo / releitura): as exportações vão buscar só os XML de que precisam,
+# sem voltar a percorrer todos os ZIP nem a correr `identify_xml_info` em cada ficheiro.
+SESSION_KEY_GARIMPO_INDICE_LOTE = "_garimpo_indice_lote"
 
-def compactar_dataframe_memoria(df):
-    """Reduz uso de RAM (categorias + downcast); seguro para filtros .str / .isin."""
-    if df is None or df.empty:
-        return df
-    out = df.copy()
-    n = len(out)
-    for col in out.columns:
-        if out[col].dtype != object and not str(out[col].dtype).startswith("string"):
-            continue
-        nu = out[col].nunique(dropna=False)
-        if nu <= 1 or nu > min(4096, max(48, n // 2)):
-            continue
-        try:
-            out[col] = out[col].astype("category")
-        except (TypeError, ValueError):
-            pass
-    for col in out.select_dtypes(include=["float64"]).columns:
-        out[col] = pd.to_numeric(out[col], downcast="float")
-    for col in out.select_dtypes(include=["int64"]).columns:
-        out[col] = pd.to_numeric(out[col], downcast="integer")
-    return out
 
+def _garimpo_indice_lote_novo(cnpj_limpo: str) -> dict:
+    """Índice vazio para uma leitura completa do lote com o CNPJ indicado."""
+    cnpj = "".join(c for c in str(cnpj_limpo or "") if c.isdigit())[:14]
+    return {"cnpj": cnpj, "fontes": [], "entradas": {}}
 
-def dataframe_para_excel_bytes(df, sheet_name="Dados"):
+
+def _garimpo_indice_lote_registar(indice: dict, f_name: str, name: str, membros, zinfo, res, is_p) -> None:
     """
-    Excel com as mesmas colunas do DataFrame (para download alinhado à tabela na tela).
-    Em disco/temp cheio (errno 28) tenta openpyxl; em falha total devolve None.
+    Regista a 1.ª ocorrência de cada tupla de dedupe (`_tupla_dedupe_export_xml`) — a mesma que as exportações
+    gravam quando percorrem o lote por ordem. `res` é o resumo sem bytes (partilhado com o lote).
+    Repetições posteriores só atualizam `ultimo` (nome/resumo que o manifesto do espelho guarda).
     """
-    if df is None or df.empty:
-        return None
-    sn = (sheet_name or "Dados")[:31]
-    dfx = df.reset_index(drop=True)
-    try:
-        buf = io.BytesIO()
-        with pd.ExcelWriter(buf, engine="xlsxwriter") as writer:
-            dfx.to_excel(writer, sheet_name=sn, index=False)
-        return buf.getvalue()
-    except Exception as exc:
-        if not _erro_sem_espaco_disco(exc):
-            raise
+    if indice is None or not res:
+        return
+    ck = _chave_para_conjunto_export(res.get("Chave"))
+    if not ck:
+        return
+    td = _tupla_dedupe_export_xml(res, ck)
+    if td is None:
+        return
+    tkey = _td_chave_serial(td)
+    ents = indice["entradas"]
+    if tkey in ents:
+        ents[tkey]["ultimo"] = (name, res, bool(is_p))
+        return
+    ents[tkey] = {
+        "fonte": f_name,
+        "membros": tuple(membros or ()),
+        "offset": int(zinfo.header_offset) if zinfo is not None else 0,
+        "tamanho": int(zinfo.compress_size) if zinfo is not None else 0,
+        "crc": int(zinfo.CRC) if zinfo is not None else 0,
+        "tamanho_xml": int(zinfo.file_size) if zinfo is not None else 0,
+        "name": name,
+        "res": res,
+        "is_p": bool(is_p),
+    }
+
+
+def _garimpo_indice_lote_guardar(indice: dict, fontes) -> None:
+    """Fecha o índice (lista de fontes lidas) e guarda-o na sessão."""
+    if indice is None:
+        return
+    indice["fontes"] = list(fontes or [])
     try:
-        buf2 = io.BytesIO()
-        with pd.ExcelWriter(buf2, engine="openpyxl") as writer:
-            dfx.to_excel(writer, sheet_name=sn, index=False)
-        return buf2.getvalue()
+        st.session_state[SESSION_KEY_GARIMPO_INDICE_LOTE] = indice
     except Exception:
-        return None
+        pass
 
 
-# Limites de linhas por tabela no PDF do dashboard (evita ficheiros gigantes).
-_DASH_PDF_MAX = {"resumo": 100, "tabela": 90, "geral": 75}
-# Colunas preferidas no relatório geral no PDF (espelho legível da página da app).
-_DASH_PDF_GERAL_COLS = [
-    "Modelo",
-    "Série",
-    "Nota",
-    "Data Emissão",
-    "Status Final",
-    "Valor",
-    "Origem",
-    "Chave",
-]
+def _garimpo_indice_lote_valido(cnpj_limpo: str):
+    """
+    Entradas do índice se ainda descrevem o lote atual (mesmas fontes e mesmo CNPJ — `is_p`/`Pasta`
+    dependem dele); senão None e quem chama volta a percorrer o lote.
+    """
+    idx = _session_state_get_garimpo(SESSION_KEY_GARIMPO_INDICE_LOTE)
+    if not isinstance(idx, dict) or not isinstance(idx.get("entradas"), dict):
+        return None
+    cnpj = "".join(c for c in str(cnpj_limpo or "") if c.isdigit())[:14]
+    if idx.get("cnpj") != cnpj:
+        return None
+    if list(idx.get("fontes") or []) != _lista_nomes_fontes_xml_garimpo():
+        return None
+    return idx["entradas"]
 
 
-def _format_celula_pdf_col(nome_col, val):
-    if val is None:
-        return "-"
+def _garimpo_membro_por_offset(fp, ent):
+    """
+    Membro comprimido da entrada do índice lido directamente no `offset` gravado na 1.ª leitura (sem abrir
+    o diretório central do ZIP), com o CRC conferido. None se o índice não tiver a posição ou o cabeçalho local
+    já não bater certo — quem chama lê então pelo nome.
+    """
+    if "crc" not in ent:
+        return None
+    membros = ent.get("membros") or ()
     try:
-        if pd.isna(val):
-            return "-"
-    except (TypeError, ValueError):
-        pass
-    nome = str(nome_col).strip().lower()
-    nome_sem_acento = "".join(
-        ch for ch in unicodedata.normalize("NFD", nome) if unicodedata.category(ch) != "Mn"
-    )
-    if "data" in nome_sem_acento and "emiss" in nome_sem_acento:
-        f = _valor_data_emissao_dd_mm_yyyy(val)
-        return f if f else "-"
-    s = str(val).strip()
-    if nome == "chave" and len(s) > 18:
-        return f"...{s[-14:]}"
-    if len(s) > 48:
-        return s[:45] + "..."
-    return s
+        membro = _zip_membro_local(
+            fp, ent["offset"], ent["tamanho"], ent["crc"], ent["tamanho_xml"], membros[-1] if membros else None
+        )
+    except (OSError, ValueError, KeyError):
+        return None
+    if membro is not None:
+        _zip_membro_verificar(membro)
+    return membro
 
 
-def _preview_df_para_pdf(df, max_rows, colunas_preferidas=None, msg_se_vazio=None):
+def _garimpo_iter_bytes_por_indice(entradas, bruto: bool = False):
     """
-    Prepara cabeçalhos e linhas para desenhar tabela no PDF.
-    Retorno: cols, rows (listas de str), total, truncated, empty_msg opcional.
+    (entrada, bytes) para cada entrada do índice, pela ordem recebida. Cada fonte é aberta uma vez e os
+    ZIP aninhados do caminho atual ficam abertos enquanto as entradas seguintes os partilharem. O XML é lido
+    pelo offset do índice (`_garimpo_membro_por_offset`): XML na raiz de um ZIP do lote nem abre o ZipFile.
+    Entradas ilegíveis (fonte removida, ZIP corrompido) são ignoradas, como na leitura normal.
+    Com `bruto`: (entrada, bytes | None, membro | None) — para membros DEFLATE de um ZIP (a qualquer nível)
+    devolve o membro comprimido de `_zip_membro_bruto` em vez de o descomprimir (bytes = None).
     """
-    if df is None or df.empty:
-        return {
-            "cols": [],
-            "rows": [],
-            "total": 0,
-            "truncated": False,
-            "empty_msg": msg_se_vazio,
-        }
-    d = df.reset_index(drop=True)
-    if colunas_preferidas:
-        existentes = [c for c in colunas_preferidas if c in d.columns]
-        if existentes:
-            d = d[existentes]
-        # se nenhuma coluna preferida existir, usa todas
-        elif not existentes:
-            pass
-    cols = [str(c) for c in d.columns]
-    total = len(d)
-    truncated = total > max_rows
-    sub = d.head(max_rows)
-    rows = []
-    for _, r in sub.iterrows():
-        rows.append([_format_celula_pdf_col(c, r[c]) for c in d.columns])
-    return {"cols": cols, "rows": rows, "total": total, "truncated": truncated, "empty_msg": None}
+    from contextlib import ExitStack
 
+    pilha = None
+    fonte_atual = None
+    f_obj = None
+    cadeia = []  # [(prefixo_membros, ZipFile)] desde a fonte até ao ZIP mais interno aberto
 
-def _preview_terceiros_para_pdf(terc_cnt):
-    if not terc_cnt:
-        return {
-            "cols": [],
-            "rows": [],
-            "total": 0,
-            "truncated": False,
-            "empty_msg": "Nenhum XML de terceiros no lote.",
-        }
-    rows = [[str(m), str(int(q))] for m, q in sorted(terc_cnt.items(), key=lambda x: x[0])]
-    return {
-        "cols": ["Modelo", "Quantidade"],
-        "rows": rows,
-        "total": len(rows),
-        "truncated": False,
-        "empty_msg": None,
-    }
+    def _fechar_cadeia(desde: int):
+        while len(cadeia) > desde:
+            _p, _z = cadeia.pop()
+            try:
+                _z.close()
+            except Exception:
+                pass
 
-
-def coletar_kpis_dashboard():
-    """Indicadores agregados para dashboard na app, Excel (folha Dashboard) e PDF."""
-    rel = st.session_state.get("relatorio") or []
-    sc = st.session_state.get("st_counts") or {}
-    df_g = st.session_state.get("df_geral")
-    df_r = st.session_state.get("df_resumo")
-    df_f = st.session_state.get("df_faltantes")
-    n_geral = len(df_g) if df_g is not None and not df_g.empty else 0
-    n_bur = len(df_f) if df_f is not None and not df_f.empty else 0
-    n_proprios = sum(1 for x in rel if "EMITIDOS_CLIENTE" in (x.get("Pasta") or ""))
-    n_terc = sum(1 for x in rel if "RECEBIDOS_TERCEIROS" in (x.get("Pasta") or ""))
-    terc_cnt = Counter()
-    for x in rel:
-        if "RECEBIDOS_TERCEIROS" in (x.get("Pasta") or ""):
-            terc_cnt[x.get("Tipo") or "Outros"] += 1
-    valor = 0.0
-    if df_r is not None and not df_r.empty and "Valor Contábil (R$)" in df_r.columns:
-        try:
-            valor = float(df_r["Valor Contábil (R$)"].sum())
-        except (TypeError, ValueError):
-            valor = 0.0
-    status_dist = {}
-    if df_g is not None and not df_g.empty and "Status Final" in df_g.columns:
-        vc = df_g["Status Final"].value_counts()
-        status_dist = {str(k): int(v) for k, v in vc.items()}
-    terc_status_dist = {}
-    if (
-        df_g is not None
-        and not df_g.empty
-        and "Origem" in df_g.columns
-        and "Status Final" in df_g.columns
-    ):
-        _m_terc = df_g["Origem"].astype(str).str.contains("TERCEIROS", case=False, na=False)
-        if _m_terc.any():
-            _vc_terc = df_g.loc[_m_terc, "Status Final"].value_counts()
-            terc_status_dist = {str(k): int(v) for k, v in _vc_terc.items()}
-    ref_ok = bool(st.session_state.get("seq_ref_ultimos"))
-    val_ok = bool(st.session_state.get("validation_done"))
-    pares = [
-        ("Gerado em", datetime.now().strftime("%d/%m/%Y %H:%M")),
-        ("Linhas no relatório geral", n_geral),
-        ("Itens no lote (relatório bruto)", len(rel)),
-        ("Autorizadas (emissão própria)", int(sc.get("AUTORIZADAS", 0) or 0)),
-        ("Canceladas (emissão própria)", int(sc.get("CANCELADOS", 0) or 0)),
-        ("Denegadas (emissão própria)", int(sc.get("DENEGADOS", 0) or 0)),
-        ("Rejeitadas (emissão própria)", int(sc.get("REJEITADOS", 0) or 0)),
-        ("Inutilizadas (emissão própria)", int(sc.get("INUTILIZADOS", 0) or 0)),
-        ("Buracos na sequência", n_bur),
-        ("XML emissão própria (itens)", n_proprios),
-        ("XML terceiros (itens)", n_terc),
-        ("Valor contábil — resumo séries (R$)", _excel_fmt_reais_pt_str(valor)),
-        ("Referência último nº guardada", "Sim" if ref_ok else "Não"),
-        ("Validação autenticidade", "Sim" if val_ok else "Não"),
-    ]
-    df_inu = st.session_state.get("df_inutilizadas")
-    df_can = st.session_state.get("df_canceladas")
-    df_aut = st.session_state.get("df_autorizadas")
-    df_den = st.session_state.get("df_denegadas")
-    df_rej = st.session_state.get("df_rejeitadas")
-    df_g_pdf_geral = df_g
-    if df_g is not None and not df_g.empty and "Origem" in df_g.columns:
-        df_g_pdf_geral = df_g.loc[_mask_emissao_propria_df(df_g)].reset_index(drop=True)
-    pdf_previews = {
-        "resumo": _preview_df_para_pdf(
-            df_r,
-            _DASH_PDF_MAX["resumo"],
-            msg_se_vazio="Sem linhas no resumo por série.",
-        ),
-        "terceiros": _preview_terceiros_para_pdf(dict(terc_cnt)),
-        "buracos": _preview_df_para_pdf(
-            df_f,
-            _DASH_PDF_MAX["tabela"],
-            msg_se_vazio="Tudo em ordem — nenhum buraco na auditoria.",
-        ),
-        "inutilizadas": _preview_df_para_pdf(
-            df_inu,
-            _DASH_PDF_MAX["tabela"],
-            msg_se_vazio="Nenhuma inutilizada listada neste detalhe.",
-        ),
-        "canceladas": _preview_df_para_pdf(
-            df_can,
-            _DASH_PDF_MAX["tabela"],
-            msg_se_vazio="Nenhuma cancelada listada neste detalhe.",
-        ),
-        "autorizadas": _preview_df_para_pdf(
-            df_aut,
-            _DASH_PDF_MAX["tabela"],
-            msg_se_vazio="Nenhuma autorizada listada neste detalhe.",
-        ),
-        "denegadas": _preview_df_para_pdf(
-            df_den,
-            _DASH_PDF_MAX["tabela"],
-            msg_se_vazio="Nenhuma denegada listada neste detalhe.",
-        ),
-        "rejeitadas": _preview_df_para_pdf(
-            df_rej,
-            _DASH_PDF_MAX["tabela"],
-            msg_se_vazio="Nenhuma rejeitada listada neste detalhe.",
-        ),
-        "geral": _preview_df_para_pdf(
-            df_g_pdf_geral,
-            _DASH_PDF_MAX["geral"],
-            _DASH_PDF_GERAL_COLS,
-            msg_se_vazio="Relatório geral vazio (emissão própria).",
-        ),
-    }
-    return {
-        "pares": pares,
-        "n_geral": n_geral,
-        "n_bur": n_bur,
-        "n_terc": n_terc,
-        "n_docs": len(rel),
-        "valor": valor,
-        "status_dist": status_dist,
-        "terc_cnt": dict(terc_cnt),
-        "terc_status_dist": terc_status_dist,
-        "sc": sc,
-        "pdf_previews": pdf_previews,
-    }
+    try:
+        for ent in entradas:
+            fonte = ent.get("fonte")
+            membros = tuple(ent.get("membros") or ())
+            try:
+                if fonte != fonte_atual:
+                    _fechar_cadeia(0)
+                    if pilha is not None:
+                        pilha.close()
+                    pilha = ExitStack()
+                    fonte_atual = fonte
+                    f_obj = pilha.enter_context(_abrir_fonte_xml_garimpo_stream(fonte))
+                if not membros:
+                    try:
+                        f_obj.seek(0)
+                    except (OSError, io.UnsupportedOperation):
+                        pass
+                    if bruto:
+                        yield ent, f_obj.read(), None
+                    else:
+                        yield ent, f_obj.read()
+                    continue
+                zips_precisos = membros[:-1]
+                if not zips_precisos:
+                    membro = _garimpo_membro_por_offset(f_obj, ent)
+                    if membro is not None:
+                        if bruto and membro[3] == zipfile.ZIP_DEFLATED:
+                            yield ent, None, membro
+                        elif bruto:
+                            yield ent, _zip_membro_bruto_dados(membro), None
+                        else:
+                            yield ent, _zip_membro_bruto_dados(membro)
+                        continue
+                comum = 0
+                while (
+                    comum < len(cadeia)
+                    and comum <= len(zips_precisos)
+                    and cadeia[comum][0] == zips_precisos[:comum]
+                ):
+                    comum += 1
+                _fechar_cadeia(comum)
+                if not cadeia:
+                    try:
+                        f_obj.seek(0)
+                    except (OSError, io.UnsupportedOperation):
+                        pass
+                    cadeia.append(((), zipfile.ZipFile(f_obj)))
+                while len(cadeia) <= len(zips_precisos):
+                    _nivel = len(cadeia)
+                    _raw_inner = cadeia[-1][1].read(zips_precisos[_nivel - 1])
+                    cadeia.append(
+                        (zips_precisos[:_nivel], zipfile.ZipFile(io.BytesIO(_raw_inner)))
+                    )
+                zc = cadeia[-1][1]
+                membro = _garimpo_membro_por_offset(zc.fp, ent) if zips_precisos else None
+                if bruto:
+                    if membro is None or membro[3] != zipfile.ZIP_DEFLATED:
+                        membro = _zip_membro_bruto(zc, membros[-1])
+                    if membro is not None:
+                        yield ent, None, membro
+                    else:
+                        yield ent, zc.read(membros[-1]), None
+                    continue
+                if membro is not None:
+                    yield ent, _zip_membro_bruto_dados(membro)
+                    continue
+                yield ent, zc.read(membros[-1])
+            except (zipfile.BadZipFile, OSError, KeyError, RuntimeError):
+                _fechar_cadeia(0)
+                continue
+    finally:
+        _fechar_cadeia(0)
+        if pilha is not None:
+            pilha.close()
 
 
-def _excel_nome_folha_seguro(nome, usados):
-    """Nomes de folha Excel: máx. 31 caracteres; sem \\ / * ? : [ ]."""
-    inv = frozenset('[]:*?/\\')
-    base = "".join(c for c in str(nome) if c not in inv).strip()[:31] or "Sheet"
-    out = base
-    k = 2
-    while out in usados:
-        suf = f" ({k})"
-        out = (base[: max(1, 31 - len(suf))] + suf).strip()
-        k += 1
-    usados.add(out)
-    return out
+def _garimpo_iter_xml_lote(cnpj_limpo: str, filtro_res=None, bruto: bool = False):
+    """
+    (nome, bytes, res, is_p) dos XML do lote, pela ordem de leitura.
+    Com índice válido: só as entradas em que `filtro_res(res, is_p)` é verdadeiro são lidas (acesso direto ao
+    membro, sem reidentificar) — uma por tupla de dedupe. Sem índice: percorre todas as fontes com
+    `identify_xml_info`, como antes. Os chamadores mantêm a sua própria dedupe (o resultado é o mesmo).
+    Com `bruto`: (nome, bytes | None, res, is_p, membro | None) — pelo índice, os XML dentro de ZIP vêm como
+    membro comprimido (`_zip_membro_bruto`, bytes = None) para cópia direta para outro ZIP; sem índice os bytes
+    já foram lidos para identificar e o membro é None.
+    """
+    entradas = _garimpo_indice_lote_valido(cnpj_limpo)
+    if entradas is not None:
+        sel = [
+            e
+            for e in entradas.values()
+            if filtro_res is None or filtro_res(e["res"], e["is_p"])
+        ]
+        _garim_trabalho_ponto(0, len(sel), "—", "Exportar")
+        if bruto:
+            for i, (ent, data, membro) in enumerate(_garimpo_iter_bytes_por_indice(sel, bruto=True)):
+                if i % _GARIM_TRABALHO_PASSO_XML == 0:
+                    _garim_trabalho_ponto(i, None, ent["name"])
+                yield ent["name"], data, ent["res"], ent["is_p"], membro
+            return
+        for i, (ent, data) in enumerate(_garimpo_iter_bytes_por_indice(sel)):
+            if i % _GARIM_TRABALHO_PASSO_XML == 0:
+                _garim_trabalho_ponto(i, None, ent["name"])
+            yield ent["name"], data, ent["res"], ent["is_p"]
+        return
+    _fontes = _lista_nomes_fontes_xml_garimpo()
+    for i, f_name in enumerate(_fontes):
+        _garim_trabalho_ponto(i + 1, len(_fontes), f_name, "Exportar")
+        with _abrir_fonte_xml_garimpo_stream(f_name) as f_temp:
+            for name, xml_data in extrair_recursivo(f_temp, f_name):
+                res, is_p = identify_xml_info(xml_data, cnpj_limpo, name)
+                if not res or (filtro_res is not None and not filtro_res(res, is_p)):
+                    del xml_data
+                    continue
+                if bruto:
+                    yield name, xml_data, res, is_p, None
+                else:
+                    yield name, xml_data, res, is_p
 
 
-def _excel_escrever_folha_df(writer, df, nome_desejado, usados):
-    """Escreve um DataFrame na folha; se vazio, cabeçalhos ou nota curta."""
-    sn = _excel_nome_folha_seguro(nome_desejado, usados)
-    if df is None:
-        pd.DataFrame({"Nota": ["Sem dados nesta vista."]}).to_excel(
-            writer, sheet_name=sn, index=False
-        )
+def _export_lote_passagem_unica(cnpj_limpo: str, destinos) -> None:
+    """
+    Uma **única** leitura do lote alimenta vários destinos de exportação (pastas do espelho, ZIPs do pacote, …).
+    Cada destino é um dict com `filtro(res, is_p)` (que XML lhe interessam) e `gravar(nome, bytes, res, is_p)`;
+    slug, dedupe e divisão em partes ficam dentro do destino, que se fecha depois com o seu `fechar()`.
+    Opcionais: `concluido()` verdadeiro → o destino sai da passagem (que termina quando não resta nenhum);
+    `tolerante` → uma exceção desse destino fica em `destino["erro"]` e só ele deixa de receber XML;
+    `aceita_bruto` → `gravar` recebe também `bruto` (membro comprimido do ZIP de origem ou None) e `bytes`
+    pode vir None. O XML só é descomprimido se algum destino sem `aceita_bruto` o quiser.
+    """
+    ativos = [d for d in destinos if d is not None]
+    if not ativos:
         return
-    d = df.reset_index(drop=True)
-    if d.empty:
-        if len(d.columns) > 0:
-            d.to_excel(writer, sheet_name=sn, index=False)
-        else:
-            pd.DataFrame({"Nota": ["Sem registos nesta vista."]}).to_excel(
-                writer, sheet_name=sn, index=False
-            )
-    else:
-        d.to_excel(writer, sheet_name=sn, index=False)
 
+    def _algum(res, is_p):
+        return any(d["filtro"](res, is_p) for d in ativos)
 
-def _excel_df_conta_par_modelo_serie(df, col_mod, col_ser):
-    if df is None or df.empty or col_mod not in df.columns or col_ser not in df.columns:
-        return {}
-    d = df[[col_mod, col_ser]].copy()
-    d["_k"] = d[col_mod].astype(str).str.strip() + "|" + d[col_ser].astype(str).str.strip()
-    return d.groupby("_k").size().to_dict()
+    for name, xml_data, res, is_p, bruto in _garimpo_iter_xml_lote(cnpj_limpo, _algum, bruto=True):
+        querem = [d for d in ativos if d["filtro"](res, is_p)]
+        if xml_data is None and any(not d.get("aceita_bruto") for d in querem):
+            try:
+                xml_data = _zip_membro_bruto_dados(bruto)
+            except zipfile.BadZipFile:
+                continue
+        for d in querem:
+            try:
+                if d.get("aceita_bruto"):
+                    d["gravar"](name, xml_data, res, is_p, bruto=bruto)
+                else:
+                    d["gravar"](name, xml_data, res, is_p)
+            except Exception as e:
+                if not d.get("tolerante"):
+                    raise
+                d["erro"] = str(e)
+                ativos.remove(d)
+                continue
+            if d.get("concluido") and d["concluido"]():
+                ativos.remove(d)
+        del xml_data
+        if not ativos:
+            return
 
 
-def _excel_fmt_milhar_pt(n):
+# --- CACHE DE IDENTIFICAÇÃO (resultado de identify_xml_info por XML) ---
+# SQLite na pasta de dados: ao reler o lote ou juntar ficheiros, os XML já vistos não são lidos do ZIP nem
+# analisados de novo. Chave: nome + CRC32 + tamanho da entrada ZIP (XML solto: SHA-1 dos bytes); guarda-se o
+# resumo sem «Conteúdo». A chave não leva o CNPJ do cliente: is_p e «Pasta» recalculam-se ao levantar
+# (`_identify_aplicar_cliente`), por isso clientes diferentes partilham os XML de terceiros que têm em comum.
+# Mudar `_GARIM_CACHE_IDENT_VERSAO` invalida a cache; outras edições do ficheiro mantêm-na.
+_GARIM_CACHE_IDENT_FICHEIRO = os.path.join(_GARIM_ROOT, "cache_identificacao.sqlite3")
+# Subir sempre que `identify_xml_info` ou `_identify_aplicar_cliente` mudarem o resumo devolvido.
+_GARIM_CACHE_IDENT_VERSAO = "1"
+# Linhas sem uso há mais do que isto saem; acima do tamanho máximo saem as mais antigas (omissão 30 dias / 512 MB).
+_GARIM_CACHE_IDENT_TTL_SEG = float(os.environ.get("GARIMPEIRO_CACHE_IDENT_DIAS", "30") or 30) * 86400
+_GARIM_CACHE_IDENT_MAX_BYTES = int(
+    float(os.environ.get("GARIMPEIRO_CACHE_IDENT_MAX_MB", "512") or 512) * 1024 * 1024
+)
+_GARIM_CACHE_IDENT_BLOCO_CONSULTA = 512
+_GARIM_CACHE_IDENT_BLOCO_ESCRITA = 2000
+
+
+def _garimpo_cache_ident_ativa() -> bool:
+    """Variável GARIMPEIRO_CACHE_IDENT=0 desliga a cache (cada leitura volta a identificar todos os XML)."""
+    v = os.environ.get("GARIMPEIRO_CACHE_IDENT", "1").strip().lower()
+    return v not in ("0", "false", "no", "off")
+
+
+_garim_app_assinatura_memo = []
+
+
+def _garim_app_assinatura() -> str:
+    """SHA-1 deste ficheiro (calculado uma vez por processo); vazio se não for legível."""
+    if not _garim_app_assinatura_memo:
+        try:
+            with open(os.path.abspath(__file__), "rb") as fh:
+                _garim_app_assinatura_memo.append(hashlib.sha1(fh.read()).hexdigest())
+        except OSError:
+            _garim_app_assinatura_memo.append("")
+    return _garim_app_assinatura_memo[0]
+
+
+def _garimpo_cache_ident_abrir():
+    """Estado da cache para uma leitura do lote, ou None (desligada / SQLite indisponível / pasta só de leitura)."""
+    if not _garimpo_cache_ident_ativa():
+        return None
+    assinatura = _GARIM_CACHE_IDENT_VERSAO
+    con = None
     try:
-        return f"{int(n):,}".replace(",", ".")
-    except (TypeError, ValueError):
-        return "-"
+        import sqlite3
+
+        con = sqlite3.connect(_GARIM_CACHE_IDENT_FICHEIRO, timeout=30, isolation_level=None)
+        con.execute("PRAGMA auto_vacuum=INCREMENTAL")  # só conta numa base nova (antes das tabelas)
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
+        con.execute("CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v TEXT)")
+        con.execute(
+            "CREATE TABLE IF NOT EXISTS ident (chave TEXT PRIMARY KEY, res TEXT, is_p INTEGER, usado REAL)"
+        )
+        con.execute("CREATE INDEX IF NOT EXISTS ident_usado ON ident (usado)")
+        row = con.execute("SELECT v FROM meta WHERE k = 'assinatura'").fetchone()
+        if not row or row[0] != assinatura:
+            con.execute("BEGIN IMMEDIATE")
+            con.execute("DELETE FROM ident")
+            con.execute("INSERT OR REPLACE INTO meta (k, v) VALUES ('assinatura', ?)", (assinatura,))
+            con.execute("COMMIT")
+    except Exception:
+        if con is not None:
+            try:
+                con.close()
+            except Exception:
+                pass
+        return None
+    # prontos: chave → [(res_json, is_p), n.º de entradas ZIP saltadas à espera deste resultado]
+    return {"con": con, "hits": 0, "misses": 0, "prontos": {}, "novos": [], "usados": []}
 
 
-def _excel_fmt_reais_pt_str(valor):
+def _garimpo_cache_ident_desligar(cache) -> None:
+    """Erro de SQLite a meio: o resto da leitura segue sem gravar nem consultar (os `prontos` continuam válidos)."""
+    con = cache.get("con")
+    cache["con"] = None
+    cache["novos"].clear()
+    cache["usados"].clear()
+    if con is not None:
+        try:
+            con.close()
+        except Exception:
+            pass
+
+
+def _garimpo_cache_ident_chave(name: str, zinfo, data) -> str | None:
+    if zinfo is not None:
+        return f"{name}|{zinfo.CRC:08x}|{zinfo.file_size}"
+    if data is None:
+        return None
     try:
-        v = float(valor)
-    except (TypeError, ValueError):
-        return "R$ 0,00"
-    neg = v < 0
-    v = abs(v)
-    cent = int(round(v * 100 + 1e-9))
-    inte, frac = divmod(cent, 100)
-    s = str(inte)
-    parts = []
-    while len(s) > 3:
-        parts.insert(0, s[-3:])
-        s = s[:-3]
-    if s:
-        parts.insert(0, s)
-    body = ".".join(parts)
-    out = f"R$ {body},{frac:02d}"
-    return f"- {out}" if neg else out
+        return f"{name}|sha1:{hashlib.sha1(data).hexdigest()}"
+    except TypeError:
+        return None
 
 
-def _excel_escrever_painel_fiscal(wb, kpi, usados_nomes):
+def _garimpo_cache_ident_consultar(cache, pedidos) -> set:
     """
-    Folha estilo dashboard (grelha tipo Excel + gráficos nativos), alinhada ao mock «Painel Fiscal».
-    Dados reais do kpi / dataframes em sessão.
+    `consultar` de `_extrair_recursivo_com_local`: [(nome, zinfo)] → {(nome, CRC, tamanho)} já em cache.
+    Os resultados ficam em `prontos` até `_garimpo_cache_ident_obter` os levantar.
     """
-    sn = _excel_nome_folha_seguro("Painel Fiscal", usados_nomes)
-    ws = wb.add_worksheet(sn)
-    # Parece mais â€œpainelâ€ / menos folha de cálculo (ideia de mock com Excel visual).
+    con = cache.get("con")
+    if con is None:
+        return set()
+    por_chave = {}
+    copias = Counter()  # a mesma entrada em várias pastas do ZIP: um levantamento por cópia
+    for name, zinfo in pedidos:
+        chave = _garimpo_cache_ident_chave(name, zinfo, None)
+        por_chave[chave] = (name, zinfo.CRC, zinfo.file_size)
+        copias[chave] += 1
+    achados = set()
+    chaves = list(por_chave)
     try:
-        ws.hide_gridlines(2)
+        for i in range(0, len(chaves), 900):  # limite de variáveis por consulta do SQLite
+            parte = chaves[i : i + 900]
+            for chave, res_j, is_p in con.execute(
+                f"SELECT chave, res, is_p FROM ident WHERE chave IN ({','.join('?' * len(parte))})", parte
+            ):
+                ent = cache["prontos"].get(chave)
+                if ent is None:
+                    cache["prontos"][chave] = [(res_j, bool(is_p)), copias[chave]]
+                else:
+                    ent[1] += copias[chave]
+                achados.add(por_chave[chave])
     except Exception:
-        pass
+        _garimpo_cache_ident_desligar(cache)
+    return achados
 
-    pm = dict(kpi.get("pares") or [])
-    sc = kpi.get("sc") or {}
-    n_docs = int(kpi.get("n_docs") or 0)
+
+def _garimpo_cache_ident_obter(cache, cnpj_limpo: str, name: str, data, zinfo):
+    """(chave, (res, is_p) ou None) — None: falta identificar e depois `_garimpo_cache_ident_guardar`."""
+    if cache is None:
+        return None, None
+    chave = _garimpo_cache_ident_chave(name, zinfo, data)
+    if chave is None:
+        return None, None
+    val = None
+    ent = cache["prontos"].get(chave)
+    if ent is not None:
+        val = ent[0]
+        ent[1] -= 1
+        if ent[1] <= 0:
+            del cache["prontos"][chave]
+    elif zinfo is None and cache.get("con") is not None:
+        try:
+            row = cache["con"].execute("SELECT res, is_p FROM ident WHERE chave = ?", (chave,)).fetchone()
+        except Exception:
+            _garimpo_cache_ident_desligar(cache)
+            row = None
+        if row:
+            val = (row[0], bool(row[1]))
+    if val is None:
+        return chave, None
     try:
-        n_prop = int(pm.get("XML emissão própria (itens)", 0) or 0)
-    except (TypeError, ValueError):
-        n_prop = 0
+        res = json.loads(val[0])
+    except ValueError:
+        return chave, None
+    is_p = False
+    if res is not None:
+        if "Conteúdo" in res:
+            res["Conteúdo"] = b""
+        if "Range" in res:
+            res["Range"] = tuple(res["Range"])
+        is_p = _identify_aplicar_cliente(res, cnpj_limpo)
+    cache["hits"] += 1
+    if cache.get("con") is not None:
+        cache["usados"].append(chave)
+        if len(cache["usados"]) >= _GARIM_CACHE_IDENT_BLOCO_ESCRITA:
+            _garimpo_cache_ident_gravar(cache)
+    return chave, (res, is_p)
+
+
+def _garimpo_cache_ident_guardar(cache, chave, res, is_p) -> None:
+    if cache is None or chave is None:
+        return
+    cache["misses"] += 1
+    if cache.get("con") is None:
+        return
     try:
-        n_terc_xml = int(pm.get("XML terceiros (itens)", 0) or 0)
+        if res is None:
+            res_j = "null"
+        else:
+            d = dict(res)
+            if "Conteúdo" in d:
+                d["Conteúdo"] = None
+            res_j = json.dumps(d, ensure_ascii=False)
     except (TypeError, ValueError):
-        n_terc_xml = 0
-    aut = int(sc.get("AUTORIZADAS", 0) or 0)
-    can = int(sc.get("CANCELADOS", 0) or 0)
-    inu = int(sc.get("INUTILIZADOS", 0) or 0)
-    den = int(sc.get("DENEGADOS", 0) or 0)
-    rej = int(sc.get("REJEITADOS", 0) or 0)
-    valor = float(kpi.get("valor") or 0)
-    n_bur = int(kpi.get("n_bur") or 0)
-    terc_cnt = kpi.get("terc_cnt") or {}
-    if not isinstance(terc_cnt, dict):
-        terc_cnt = {}
+        return
+    cache["novos"].append((chave, res_j, 1 if is_p else 0))
+    if len(cache["novos"]) >= _GARIM_CACHE_IDENT_BLOCO_ESCRITA:
+        _garimpo_cache_ident_gravar(cache)
 
-    df_r = st.session_state.get("df_resumo")
-    df_aut = st.session_state.get("df_autorizadas")
-    df_can = st.session_state.get("df_canceladas")
-    df_inu = st.session_state.get("df_inutilizadas")
-    df_bur = st.session_state.get("df_faltantes")
-    if df_bur is not None and not df_bur.empty:
-        if "Serie" in df_bur.columns and "Série" not in df_bur.columns:
-            df_bur = df_bur.rename(columns={"Serie": "Série"})
 
-    c_aut = _excel_df_conta_par_modelo_serie(df_aut, "Modelo", "Série")
-    c_can = _excel_df_conta_par_modelo_serie(df_can, "Modelo", "Série")
-    c_inu = _excel_df_conta_par_modelo_serie(df_inu, "Modelo", "Série")
-    c_bur = _excel_df_conta_par_modelo_serie(df_bur, "Tipo", "Série")
+def _garimpo_cache_ident_gravar(cache) -> None:
+    """Grava resultados novos e renova a data de uso das linhas lidas (no máx. 1×/dia por linha)."""
+    con = cache.get("con")
+    if con is None or not (cache["novos"] or cache["usados"]):
+        return
+    agora = time.time()
+    try:
+        con.execute("BEGIN IMMEDIATE")
+        if cache["novos"]:
+            con.executemany(
+                "INSERT OR REPLACE INTO ident (chave, res, is_p, usado) VALUES (?, ?, ?, ?)",
+                [(c, r, p, agora) for c, r, p in cache["novos"]],
+            )
+        if cache["usados"]:
+            con.executemany(
+                "UPDATE ident SET usado = ? WHERE chave = ? AND usado < ?",
+                [(agora, c, agora - 86400) for c in cache["usados"]],
+            )
+        con.execute("COMMIT")
+    except Exception:
+        _garimpo_cache_ident_desligar(cache)
+        return
+    cache["novos"].clear()
+    cache["usados"].clear()
 
-    mes_ref = datetime.now().strftime("%m/%Y")
-    ref_txt = "Sim" if pm.get("Referência último nº guardada") == "Sim" else "Não"
-    val_txt = "Sim" if pm.get("Validação autenticidade") == "Sim" else "Não"
-    _df_div = st.session_state.get("df_divergencias")
-    if _df_div is not None and isinstance(_df_div, pd.DataFrame) and not _df_div.empty:
-        n_div = len(_df_div)
-    else:
-        n_div = 0
 
-    cor_fundo = "#FDFBF7"
-    cor_vinho = "#5D1B36"
-    cor_borda = "#A1869E"
-    cor_texto = "#20232A"
-    marrom = cor_vinho
+def _garimpo_cache_ident_fechar(cache) -> None:
+    """Fim da leitura: grava o pendente, apaga linhas expiradas e, acima do tamanho máximo, as mais antigas."""
+    if cache is None or cache.get("con") is None:
+        return
+    _garimpo_cache_ident_gravar(cache)
+    con = cache.get("con")
+    if con is None:
+        return
+    try:
+        con.execute("DELETE FROM ident WHERE usado < ?", (time.time() - _GARIM_CACHE_IDENT_TTL_SEG,))
+        paginas = con.execute("PRAGMA page_count").fetchone()[0] - con.execute("PRAGMA freelist_count").fetchone()[0]
+        ocupado = paginas * con.execute("PRAGMA page_size").fetchone()[0]
+        if ocupado > _GARIM_CACHE_IDENT_MAX_BYTES:
+            n = con.execute("SELECT COUNT(*) FROM ident").fetchone()[0]
+            # Desce para ~80 % do máximo.
+            cortar = int(n * (1.0 - 0.8 * _GARIM_CACHE_IDENT_MAX_BYTES / ocupado)) + 1
+            con.execute(
+                "DELETE FROM ident WHERE chave IN (SELECT chave FROM ident ORDER BY usado LIMIT ?)", (cortar,)
+            )
+        con.execute("PRAGMA incremental_vacuum").fetchall()  # só corre ao percorrer o cursor
+    except Exception:
+        pass
+    _garimpo_cache_ident_desligar(cache)
 
-    fmt_fundo = wb.add_format({"bg_color": cor_fundo})
-    fmt_titulo_dash = wb.add_format(
-        {
-            "bold": True,
-            "font_color": cor_vinho,
-            "bg_color": cor_fundo,
-            "font_size": 14,
-            "valign": "vcenter",
-            "align": "center",
-        }
-    )
-    fmt_titulo_card = wb.add_format(
-        {
-            "bold": True,
-            "font_color": cor_texto,
-            "bg_color": "#FFFFFF",
-            "top": 2,
-            "left": 2,
-            "right": 2,
-            "top_color": cor_borda,
-            "left_color": cor_borda,
-            "right_color": cor_borda,
-            "font_size": 9,
-            "align": "center",
-            "valign": "vcenter",
-            "text_wrap": True,
-        }
-    )
-    fmt_valor_card = wb.add_format(
-        {
-            "bold": True,
-            "font_color": cor_texto,
-            "bg_color": "#FFFFFF",
-            "left": 2,
-            "right": 2,
-            "left_color": cor_borda,
-            "right_color": cor_borda,
-            "font_size": 16,
-            "align": "center",
-            "valign": "vcenter",
-        }
-    )
-    fmt_rodape_card = wb.add_format(
-        {
-            "font_color": cor_texto,
-            "bg_color": "#FFFFFF",
-            "bottom": 2,
-            "left": 2,
-            "right": 2,
-            "bottom_color": cor_borda,
-            "left_color": cor_borda,
-            "right_color": cor_borda,
-            "font_size": 9,
-            "align": "center",
-            "valign": "top",
-            "text_wrap": True,
-        }
-    )
-    fmt_kpi_t = wb.add_format(
-        {
-            "bold": True,
-            "font_size": 10,
-            "font_color": cor_vinho,
-            "bg_color": cor_fundo,
-            "border": 1,
-            "border_color": cor_borda,
-            "text_wrap": True,
-            "valign": "vcenter",
-        }
-    )
-    fmt_kpi_l = wb.add_format(
-        {
-            "font_size": 9,
-            "border": 1,
-            "text_wrap": True,
-            "valign": "vcenter",
-            "bg_color": "#FFFFFF",
-        }
-    )
-    fmt_tab_h = wb.add_format(
-        {
-            "bold": True,
-            "font_color": "#FFFFFF",
-            "bg_color": marrom,
-            "border": 1,
-            "align": "center",
-            "valign": "vcenter",
-            "text_wrap": True,
-        }
-    )
-    fmt_tab_c = wb.add_format({"border": 1, "valign": "vcenter"})
-    fmt_tab_warn = wb.add_format({"border": 1, "font_color": "#C62828", "bold": True})
-    fmt_tab_ok = wb.add_format({"border": 1, "font_color": "#2E7D32"})
-    fmt_foot = wb.add_format({"italic": True, "font_size": 9, "font_color": "#777777"})
 
-    for row in range(0, 42):
-        ws.set_row(row, 20, fmt_fundo)
-    ws.set_row(0, 26)
-    ws.set_row(1, 22)
-    ws.set_column(0, 0, 4, fmt_fundo)
-    ws.set_column(1, 12, 13, fmt_fundo)
+def _garimpo_cache_ident_resumo(ctx) -> str:
+    """Sufixo do rodapé com acertos/consultas da cache de identificação (vazio sem cache)."""
+    cache = (ctx or {}).get("cache")
+    if not cache:
+        return ""
+    total = cache["hits"] + cache["misses"]
+    if not total:
+        return ""
+    return f" · cache {cache['hits']}/{total}"
 
-    ws.merge_range(0, 1, 0, 12, "GARIMPEIRO | PAINEL FISCAL", fmt_titulo_dash)
-    ws.merge_range(1, 1, 1, 12, "Olá! Bem-vinda à sua boutique de dados.", fmt_titulo_dash)
 
-    terc_rodape = []
-    try:
-        itens = sorted(terc_cnt.items(), key=lambda x: int(x[1] or 0), reverse=True)
-        for mod, q in itens[:2]:
-            terc_rodape.append(f"{str(mod).strip()}: {_excel_fmt_milhar_pt(int(q or 0))}")
-    except Exception:
-        terc_rodape = []
-    if not terc_rodape:
-        terc_rodape = ["—"]
+# --- LOTE DA LEITURA ---
+# Durante a leitura, o lote guarda um resumo `identify_xml_info` por chave (fusão por chave: a 1.ª ocorrência
+# fica, e a posição dela; um evento que substitui troca o resumo) até passar às colunas do relatório e à
+# auditoria de buracos. Fica em memória, tal como o relatório e os DataFrames montados a seguir — guardar só
+# o lote em disco não baixaria o pico de RAM de um garimpo.
 
-    ws.merge_range(3, 1, 3, 3, "TOTAL DE DOCUMENTOS\nLIDOS (NUM GERAL)", fmt_titulo_card)
-    ws.merge_range(4, 1, 5, 3, _excel_fmt_milhar_pt(n_docs), fmt_valor_card)
-    ws.merge_range(
-        6,
-        1,
-        7,
-        3,
-        f"Próprios: {_excel_fmt_milhar_pt(n_prop)}\nTerceiros: {_excel_fmt_milhar_pt(n_terc_xml)}",
-        fmt_rodape_card,
-    )
 
-    ws.merge_range(3, 4, 3, 6, "DETALHAMENTO\nEMISSÃO PRÓPRIA", fmt_titulo_card)
-    ws.merge_range(4, 4, 5, 6, f"{_excel_fmt_milhar_pt(aut)} Aut.", fmt_valor_card)
-    ws.merge_range(
-        6,
-        4,
-        7,
-        6,
-        f"Canceladas: {_excel_fmt_milhar_pt(can)}\nInutilizadas: {_excel_fmt_milhar_pt(inu)}\n"
-        f"Denegadas: {_excel_fmt_milhar_pt(den)}\nRejeitadas: {_excel_fmt_milhar_pt(rej)}",
-        fmt_rodape_card,
-    )
+def _garimpo_lote_novo() -> dict:
+    """Lote de uma leitura: {chave: (resumo, is_p)} pela ordem da 1.ª leitura de cada chave."""
+    return {}
 
-    ws.merge_range(3, 7, 3, 9, "DETALHAMENTO\nDOCUMENTOS TERCEIROS", fmt_titulo_card)
-    ws.merge_range(4, 7, 5, 9, f"{_excel_fmt_milhar_pt(n_terc_xml)} Terc.", fmt_valor_card)
-    ws.merge_range(6, 7, 7, 9, "\n".join(terc_rodape), fmt_rodape_card)
 
-    ws.merge_range(3, 10, 3, 12, "VOLUME\nFINANCEIRO", fmt_titulo_card)
-    ws.merge_range(4, 10, 5, 12, _excel_fmt_reais_pt_str(valor), fmt_valor_card)
-    ws.merge_range(6, 10, 7, 12, "", fmt_rodape_card)
+def _garimpo_lote_registar(lote, res, is_p) -> None:
+    """Junta `res` ao lote com as regras de fusão por chave da leitura."""
+    key = res["Chave"]
+    if key not in lote or res["Status"] in _RELATORIO_STATUS_SUBSTITUI:
+        lote[key] = (res, is_p)
 
-    chart_row = 10
 
-    # Dados ocultos para gráficos (colunas Q-S = 16+)
-    hid_c = 16
-    r0 = 40
-    ws.write(r0, hid_c, "Categoria", fmt_kpi_l)
-    ws.write(r0, hid_c + 1, "Valor", fmt_kpi_l)
-    ws.write(r0 + 1, hid_c, "Autorizadas")
-    ws.write_number(r0 + 1, hid_c + 1, max(0, aut))
-    ws.write(r0 + 2, hid_c, "Canceladas")
-    ws.write_number(r0 + 2, hid_c + 1, max(0, can))
-    ws.write(r0 + 3, hid_c, "Inutilizadas")
-    ws.write_number(r0 + 3, hid_c + 1, max(0, inu))
-    ws.write(r0 + 4, hid_c, "Denegadas")
-    ws.write_number(r0 + 4, hid_c + 1, max(0, den))
-    ws.write(r0 + 5, hid_c, "Rejeitadas")
-    ws.write_number(r0 + 5, hid_c + 1, max(0, rej))
+def _garimpo_lote_n(lote) -> int:
+    """N.º de documentos únicos (chaves) no lote."""
+    return len(lote)
 
-    r1 = r0 + 8
-    terc_items = sorted(terc_cnt.items(), key=lambda x: -x[1])[:8]
-    if not terc_items:
-        ws.write(r1, hid_c, "—")
-        ws.write_number(r1, hid_c + 1, 1)
-        n_trows = 1
-    else:
-        n_trows = 0
-        for mod, q in terc_items:
-            ws.write(r1 + n_trows, hid_c, str(mod))
-            ws.write_number(r1 + n_trows, hid_c + 1, int(q))
-            n_trows += 1
 
-    r2 = r1 + max(n_trows, 1) + 2
-    ws.write(r2, hid_c, "Própria (aut.)")
-    ws.write_number(r2, hid_c + 1, max(0, aut))
-    ws.write(r2 + 1, hid_c, "Terceiros (XML)")
-    ws.write_number(r2 + 1, hid_c + 1, max(0, n_terc_xml))
+def _garimpo_lote_itens(lote):
+    """(res, is_p) pela ordem da 1.ª leitura de cada chave."""
+    return iter(lote.values())
 
-    ws.set_column(hid_c, hid_c + 1, None, None, {"hidden": True})
 
-    ch1 = wb.add_chart({"type": "doughnut"})
-    ch1.add_series(
-        {
-            "name": "Emissão própria",
-            "categories": [sn, r0 + 1, hid_c, r0 + 5, hid_c],
-            "values": [sn, r0 + 1, hid_c + 1, r0 + 5, hid_c + 1],
-        }
-    )
-    ch1.set_title({"name": f"STATUS DE EMISSÃO PRÓPRIA ({mes_ref})"})
-    ch1.set_style(10)
-    ws.insert_chart(chart_row, 0, ch1, {"x_scale": 0.95, "y_scale": 0.95})
+def _garimpo_lote_fechar(lote) -> None:
+    """Liberta o lote."""
+    lote.clear()
 
-    ch2 = wb.add_chart({"type": "doughnut"})
-    last_tr = r1 + n_trows - 1
-    ch2.add_series(
-        {
-            "name": "Terceiros",
-            "categories": [sn, r1, hid_c, last_tr, hid_c],
-            "values": [sn, r1, hid_c + 1, last_tr, hid_c + 1],
-        }
-    )
-    ch2.set_title({"name": f"DISTRIBUIÇÃO TERCEIROS POR MODELO ({mes_ref})"})
-    ch2.set_style(10)
-    ws.insert_chart(chart_row, 5, ch2, {"x_scale": 0.95, "y_scale": 0.95})
 
-    ch3 = wb.add_chart({"type": "area"})
-    ch3.add_series(
-        {
-            "name": "No lote",
-            "categories": [sn, r2, hid_c, r2 + 1, hid_c],
-            "values": [sn, r2, hid_c + 1, r2 + 1, hid_c + 1],
-            "fill": {"color": cor_borda},
-            "line": {"color": cor_vinho},
-        }
-    )
-    ch3.set_title({"name": "RESUMO RÁPIDO (autorizadas própria vs XML terceiros)"})
-    ch3.set_legend({"none": True})
-    ws.insert_chart(chart_row, 10, ch3, {"x_scale": 0.95, "y_scale": 0.95})
+# --- IDENTIFICAÇÃO EM PARALELO (grande garimpo / releitura) ---
+# Os XML de cada fonte seguem em blocos para processos «worker» que devolvem só o resumo (sem bytes);
+# a fusão por chave continua no script, pela ordem de leitura — resultado igual ao modo série.
+_GARIM_IDENT_BLOCO_XML = 256
+_GARIM_IDENT_BLOCOS_EM_VOO_POR_WORKER = 2
+# Abaixo disto o arranque dos processos (importam pandas/streamlit) custa mais do que poupa.
+_GARIM_IDENT_MIN_XML_PARA_POOL = int(os.environ.get("GARIMPEIRO_IDENT_MIN_XML_POOL", "10000"))
 
-    # Alertas de série (séries com buracos) — à direita, acima dos gráficos
-    alert_row = 3
-    ws.write(alert_row, 14, "ALERTAS DE SÉRIE", fmt_kpi_t)
-    if df_bur is not None and not df_bur.empty and "Tipo" in df_bur.columns and "Série" in df_bur.columns:
-        gb = df_bur.groupby(["Tipo", "Série"]).size().reset_index(name="n")
-        gb = gb.sort_values("n", ascending=False).head(8)
-        ar = alert_row + 1
-        for _, rr in gb.iterrows():
-            ws.write(ar, 14, f"{rr['Tipo']} sér. {rr['Série']}: {int(rr['n'])} buraco(s)", fmt_tab_warn)
-            ar += 1
-            if ar > alert_row + 6:
-                break
-        if ar == alert_row + 1:
-            ws.write(ar, 14, "Nenhum buraco listado.", fmt_tab_ok)
-    else:
-        ws.write(alert_row + 1, 14, "Sem buracos ou dados indisponíveis.", fmt_tab_ok)
 
-    ctx_r = alert_row + 10
-    ws.write(ctx_r, 14, f"Último nº guardado: {ref_txt}", fmt_kpi_l)
-    ws.write(ctx_r + 1, 14, f"Autenticidade: {val_txt}", fmt_kpi_l)
-    if n_div:
-        ws.write(ctx_r + 2, 14, f"Divergências XML×Sefaz: {n_div}", fmt_tab_warn)
-
-    # Tabela totalizador (abaixo dos gráficos)
-    t_row = chart_row + 16
-    ws.merge_range(
-        t_row,
-        0,
-        t_row,
-        8,
-        f"TOTALIZADOR DE SÉRIE E FAIXAS ({mes_ref})",
-        fmt_kpi_t,
-    )
-    t_row += 1
-    headers = [
-        "Modelo",
-        "Série",
-        "Faixa (início–fim)",
-        "Qtd lidos",
-        "Autorizadas",
-        "Canceladas",
-        "Inutilizadas",
-        "Buracos",
-        "OK?",
-    ]
-    for c, h in enumerate(headers):
-        ws.write(t_row, c, h, fmt_tab_h)
-    t_row += 1
-
-    if df_r is not None and not df_r.empty:
-        doc_col = "Documento" if "Documento" in df_r.columns else None
-        ser_col = "Série" if "Série" in df_r.columns else None
-        if doc_col and ser_col:
-            for _, row in df_r.iterrows():
-                mod = str(row.get(doc_col, "")).strip()
-                ser = str(row.get(ser_col, "")).strip()
-                k = f"{mod}|{ser}"
-                ini = row.get("Início", "")
-                fim = row.get("Fim", "")
-                faixa = f"{ini} – {fim}"
-                qtd = row.get("Quantidade", "")
-                na = int(c_aut.get(k, 0))
-                nc = int(c_can.get(k, 0))
-                ni = int(c_inu.get(k, 0))
-                nb = int(c_bur.get(k, 0))
-                ok = "\u2713" if nb == 0 else "\u25b2"
-                fmt_end = fmt_tab_ok if nb == 0 else fmt_tab_warn
-                ws.write(t_row, 0, mod, fmt_tab_c)
-                ws.write(t_row, 1, ser, fmt_tab_c)
-                ws.write(t_row, 2, faixa, fmt_tab_c)
-                ws.write(t_row, 3, qtd, fmt_tab_c)
-                ws.write_number(t_row, 4, na, fmt_tab_c)
-                ws.write_number(t_row, 5, nc, fmt_tab_c)
-                ws.write_number(t_row, 6, ni, fmt_tab_c)
-                ws.write_number(t_row, 7, nb, fmt_tab_c)
-                ws.write(t_row, 8, ok, fmt_end)
-                t_row += 1
-        else:
-            ws.merge_range(t_row, 0, t_row, 8, "Resumo por série sem colunas esperadas.", fmt_tab_c)
-            t_row += 1
-    else:
-        ws.merge_range(t_row, 0, t_row, 8, "Sem resumo por série neste lote.", fmt_tab_c)
-        t_row += 1
+def _garimpo_workers_identificacao() -> int:
+    """
+    Processos para `identify_xml_info` no grande garimpo. Variável GARIMPEIRO_IDENT_WORKERS:
+    0 ou 1 = série (sem processos); N = N processos; em branco = automático (núcleos − 1, máx. 8;
+    série na Streamlit Community Cloud, onde a memória é curta).
+    """
+    raw = (os.environ.get("GARIMPEIRO_IDENT_WORKERS") or "").strip()
+    if raw:
+        try:
+            return max(1, min(int(raw), 64))
+        except ValueError:
+            return 1
+    if _streamlit_likely_community_cloud():
+        return 1
+    return max(1, min((os.cpu_count() or 1) - 1, 8))
 
-    t_row += 1
-    ws.merge_range(t_row, 0, t_row, 8, "Garimpeiro · Painel gerado a partir do lote atual (mesmos dados que na app).", fmt_foot)
 
-    ws.set_column(0, 0, 12)
-    ws.set_column(1, 1, 10)
-    ws.set_column(2, 2, 24)
-    ws.set_column(3, 8, 11)
-    ws.set_column(14, 15, 20)
+def _garimpo_identificar_bloco_worker(cnpj_limpo, itens):
+    """Corre no processo worker: [(nome, bytes)] → ([(res, is_p)], falhou_a_meio)."""
+    out = []
+    for name, data in itens:
+        try:
+            out.append(identify_xml_info(data, cnpj_limpo, name))
+        except Exception:
+            return out, True
+    return out, False
 
 
-def _excel_relatorio_geral_openpyxl_fallback_bytes(
-    df_g,
-    df_bur,
-    df_inu,
-    df_can,
-    df_aut,
-    df_den,
-    df_rej,
-    df_cte,
-    df_terc_rows,
-    *,
-    omit_bur_inu: bool,
-    kpi: dict,
-    incluir_painel_fiscal: bool,
-):
+@contextmanager
+def _garimpo_pool_identificacao():
     """
-    Mesmas folhas de dados que o livro principal, sem layout xlsxwriter (dashboard formatado / painel fiscal).
-    Usado quando xlsxwriter falha por disco ou temp cheio (errno 28).
+    Contexto de uma leitura completa do lote. O pool só arranca depois de `_GARIM_IDENT_MIN_XML_PARA_POOL`
+    XML por identificar e só recebe blocos cheios de uma fonte (XML soltos e lotes pequenos ficam em série, sem
+    custo de arranque); fecha-se à saída, tal como a cache de identificação.
     """
-    buf = io.BytesIO()
-    usados = set()
+    ctx = {
+        "workers": _garimpo_workers_identificacao(),
+        "pool": None,
+        "pool_falhou": False,
+        "xml_lidos": 0,
+        "cache": _garimpo_cache_ident_abrir(),
+    }
     try:
-        with pd.ExcelWriter(buf, engine="openpyxl") as writer:
-            _excel_escrever_folha_df(writer, df_g, "Geral", usados)
-            if not omit_bur_inu:
-                _excel_escrever_folha_df(writer, df_bur, "Buracos", usados)
-                _excel_escrever_folha_df(writer, df_inu, "Inutilizadas", usados)
-            _excel_escrever_folha_df(writer, df_can, "Canceladas", usados)
-            _excel_escrever_folha_df(writer, df_aut, "Autorizadas", usados)
-            _excel_escrever_folha_df(writer, df_den, "Denegadas", usados)
-            _excel_escrever_folha_df(writer, df_rej, "Rejeitadas", usados)
-            _excel_escrever_folha_df(writer, df_cte, "CT-e e CT-e OS", usados)
-            _excel_escrever_folha_df(writer, df_terc_rows, "Terceiros lidas", usados)
-            par = kpi.get("pares") or []
-            if par:
-                df_d = pd.DataFrame(list(par), columns=["Indicador", "Valor"])
-            else:
-                df_d = pd.DataFrame(
-                    {
-                        "Aviso": [
-                            "Export alternativo (sem espaço para xlsxwriter em disco/Temp). "
-                            "Liberte espaço no disco onde está a pasta **temp_windows_ambiente** do Garimpeiro (ou defina **GARIMPEIRO_DATA_ROOT** noutro volume)."
-                        ]
-                    }
-                )
-            _excel_escrever_folha_df(writer, df_d, "Dashboard", usados)
-            df_r = st.session_state.get("df_resumo")
-            if df_r is not None and isinstance(df_r, pd.DataFrame) and not df_r.empty:
-                _excel_escrever_folha_df(writer, df_r, "Resumo por série", usados)
-            tc = kpi.get("terc_cnt") or {}
-            if tc:
-                df_tc = pd.DataFrame(
-                    [
-                        {"Modelo": m, "Quantidade": int(q)}
-                        for m, q in sorted(tc.items(), key=lambda x: str(x[0]))
-                    ]
-                )
-                _excel_escrever_folha_df(writer, df_tc, "Terceiros qtd", usados)
-            if incluir_painel_fiscal:
-                df_pf = pd.DataFrame(
-                    {
-                        "Nota": [
-                            "Painel fiscal: só no export completo (xlsxwriter). "
-                            "Liberte espaço no disco da pasta **temp_windows_ambiente** do Garimpeiro e exporte de novo."
-                        ]
-                    }
-                )
-                _excel_escrever_folha_df(writer, df_pf, "Painel fiscal", usados)
-        return buf.getvalue()
-    except Exception:
-        return None
+        yield ctx
+    finally:
+        pool = ctx.get("pool")
+        if pool is not None:
+            try:
+                pool.shutdown(wait=True, cancel_futures=True)
+            except Exception:
+                pass
+        _garimpo_cache_ident_fechar(ctx.get("cache"))
 
 
-def excel_relatorio_geral_com_dashboard_bytes(
-    df_geral, *, incluir_painel_fiscal: bool = True, folhas_detalhe: dict | None = None
-):
-    """
-    Excel com várias folhas alinhadas às abas da página da app:
-    Geral, Buracos, Inutilizadas, Canceladas, Autorizadas, Denegadas, Rejeitadas, CT-e e CT-e OS, Terceiros lidas, Dashboard;
-    opcionalmente Painel Fiscal (incluir_painel_fiscal=False para pacote contabilidade).
-    Se ``folhas_detalhe`` for um dict com chaves df_bur, df_inu, df_can, df_aut, df_den, df_rej,
-    usa esses DataFrames em vez dos da sessão (ex.: livro só «terceiros»). Se df_bur e df_inu
-    vierem vazios (caso típico terceiros), as folhas Buracos e Inutilizadas não são criadas.
-    """
-    if df_geral is None or df_geral.empty:
+def _garimpo_pool_obter(ctx):
+    """Pool de processos do contexto (criado na 1.ª chamada) ou None se o modo for série / o arranque falhou."""
+    if not ctx or ctx.get("workers", 1) < 2 or ctx.get("pool_falhou"):
         return None
-    kpi = coletar_kpis_dashboard()
-    usados_nomes = set()
+    if ctx.get("pool") is None:
+        try:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
 
-    if folhas_detalhe is None:
-        df_bur = st.session_state.get("df_faltantes")
-        df_inu = st.session_state.get("df_inutilizadas")
-        df_can = st.session_state.get("df_canceladas")
-        df_aut = st.session_state.get("df_autorizadas")
-        df_den = st.session_state.get("df_denegadas")
-        df_rej = st.session_state.get("df_rejeitadas")
-    else:
-        df_bur = folhas_detalhe.get("df_bur")
-        df_inu = folhas_detalhe.get("df_inu")
-        df_can = folhas_detalhe.get("df_can")
-        df_aut = folhas_detalhe.get("df_aut")
-        df_den = folhas_detalhe.get("df_den")
-        df_rej = folhas_detalhe.get("df_rej")
-        if df_bur is None or not isinstance(df_bur, pd.DataFrame):
-            df_bur = pd.DataFrame()
-        if df_inu is None or not isinstance(df_inu, pd.DataFrame):
-            df_inu = pd.DataFrame()
-        if df_can is None or not isinstance(df_can, pd.DataFrame):
-            df_can = pd.DataFrame()
-        if df_aut is None or not isinstance(df_aut, pd.DataFrame):
-            df_aut = pd.DataFrame()
-        if df_den is None or not isinstance(df_den, pd.DataFrame):
-            df_den = pd.DataFrame()
-        if df_rej is None or not isinstance(df_rej, pd.DataFrame):
-            df_rej = pd.DataFrame()
+            # spawn: o servidor Streamlit tem threads — fork não é seguro; os workers importam este ficheiro.
+            ctx["pool"] = ProcessPoolExecutor(
+                max_workers=ctx["workers"], mp_context=multiprocessing.get_context("spawn")
+            )
+        except Exception:
+            ctx["pool_falhou"] = True
+            return None
+    return ctx["pool"]
 
-    df_g = df_geral.reset_index(drop=True)
-    df_g = _df_com_data_emissao_dd_mm_yyyy(df_g)
-    if "Modelo" in df_g.columns:
-        _m = df_g["Modelo"].astype(str).str.strip()
-        df_cte = df_g[_m.isin(("CT-e", "CT-e OS"))].copy()
-    else:
-        df_cte = pd.DataFrame()
-    if "Origem" in df_g.columns:
-        df_terc_rows = df_g[
-            df_g["Origem"].astype(str).str.contains("TERCEIROS", case=False, na=False)
-        ].copy()
-    else:
-        df_terc_rows = pd.DataFrame()
 
-    df_bur = _df_com_data_emissao_dd_mm_yyyy(df_bur)
-    df_inu = _df_com_data_emissao_dd_mm_yyyy(df_inu)
-    df_can = _df_com_data_emissao_dd_mm_yyyy(df_can)
-    df_aut = _df_com_data_emissao_dd_mm_yyyy(df_aut)
-    df_den = _df_com_data_emissao_dd_mm_yyyy(df_den)
-    df_rej = _df_com_data_emissao_dd_mm_yyyy(df_rej)
+def _garimpo_identificar_fonte(ctx, file_obj, f_name: str, cnpj_limpo: str):
+    """
+    (nome, membros, zinfo, res, is_p) de cada XML da fonte, pela ordem de leitura — da cache de identificação,
+    em série ou pelo pool de `_garimpo_pool_identificacao`. Como no modo série, um erro a meio da fonte
+    interrompe o resto dela (a exceção sobe depois de entregues os XML anteriores). Se o pool falhar, os blocos
+    pendentes são identificados aqui e o resto do lote segue em série.
+    """
+    cache = ctx.get("cache") if ctx else None
+    if cache is not None:
+        cache["prontos"].clear()
+    consultar = (lambda pedidos: _garimpo_cache_ident_consultar(cache, pedidos)) if cache is not None else None
+    todos_xmls = extrair_fonte_xml_garimpo_com_local(file_obj, f_name, consultar=consultar)
+    if not ctx or ctx.get("workers", 1) < 2 or ctx.get("pool_falhou"):
+        for name, xml_data, membros, zinfo in todos_xmls:
+            chave_c, pronto = _garimpo_cache_ident_obter(cache, cnpj_limpo, name, xml_data, zinfo)
+            if pronto is None:
+                pronto = identify_xml_info(xml_data, cnpj_limpo, name)
+                _garimpo_cache_ident_guardar(cache, chave_c, *pronto)
+            del xml_data
+            yield name, membros, zinfo, pronto[0], pronto[1]
+        return
 
-    # Livro só terceiros: buracos/inutilizadas não existem — não criar folhas vazias.
-    _omit_bur_inu = (
-        folhas_detalhe is not None
-        and df_bur.empty
-        and df_inu.empty
-    )
+    # locais: (membros, zinfo, chave da cache, (res, is_p) da cache ou None); só os None vão ao pool.
+    pendentes = deque()  # (future | None, [(nome, bytes)], [locais])
+    max_em_voo = max(1, ctx["workers"] * _GARIM_IDENT_BLOCOS_EM_VOO_POR_WORKER)
 
-    try:
-        buf = io.BytesIO()
-        with pd.ExcelWriter(buf, engine="xlsxwriter") as writer:
-            _excel_escrever_folha_df(writer, df_g, "Geral", usados_nomes)
-            if not _omit_bur_inu:
-                _excel_escrever_folha_df(writer, df_bur, "Buracos", usados_nomes)
-                _excel_escrever_folha_df(writer, df_inu, "Inutilizadas", usados_nomes)
-            _excel_escrever_folha_df(writer, df_can, "Canceladas", usados_nomes)
-            _excel_escrever_folha_df(writer, df_aut, "Autorizadas", usados_nomes)
-            _excel_escrever_folha_df(writer, df_den, "Denegadas", usados_nomes)
-            _excel_escrever_folha_df(writer, df_rej, "Rejeitadas", usados_nomes)
-            _excel_escrever_folha_df(writer, df_cte, "CT-e e CT-e OS", usados_nomes)
-            _excel_escrever_folha_df(writer, df_terc_rows, "Terceiros lidas", usados_nomes)
-
-            wb = writer.book
-            dash_sn = _excel_nome_folha_seguro("Dashboard", usados_nomes)
-            ws = wb.add_worksheet(dash_sn)
-            title_f = wb.add_format(
-                {"bold": True, "font_size": 16, "font_color": "#AD1457", "valign": "vcenter"}
-            )
-            hdr_f = wb.add_format(
-                {"bold": True, "bg_color": "#F8BBD0", "border": 1, "valign": "vcenter"}
-            )
-            cell_f = wb.add_format({"border": 1, "valign": "vcenter"})
-            sub_f = wb.add_format({"bold": True, "font_size": 11, "bg_color": "#FCE4EC", "border": 1})
-
-            ws.merge_range(0, 0, 0, 3, "Garimpeiro — Dashboard", title_f)
-            ws.set_row(0, 26)
-            row = 2
-            ws.write(row, 0, "Indicador", hdr_f)
-            ws.write(row, 1, "Valor", hdr_f)
-            row += 1
-            for lab, val in kpi["pares"]:
-                ws.write(row, 0, lab, cell_f)
-                ws.write(row, 1, val, cell_f)
-                row += 1
-            row += 1
+    def _em_serie(itens, locais):
+        for (name, data), (membros, zinfo, chave_c, pronto) in zip(itens, locais):
+            if pronto is None:
+                pronto = identify_xml_info(data, cnpj_limpo, name)
+                _garimpo_cache_ident_guardar(cache, chave_c, *pronto)
+            yield name, membros, zinfo, pronto[0], pronto[1]
 
-            df_r = st.session_state.get("df_resumo")
-            if df_r is not None and not df_r.empty:
-                last_c = max(5, len(df_r.columns) - 1)
-                ws.merge_range(
-                    row,
-                    0,
-                    row,
-                    last_c,
-                    "Resumo por série (NF-e / NFC-e / NFS-e, emitente = CNPJ da barra lateral)",
-                    sub_f,
-                )
-                row += 1
-                for c, colname in enumerate(df_r.columns):
-                    ws.write(row, c, str(colname), hdr_f)
-                row += 1
-                for _, rr in df_r.iterrows():
-                    for c, colname in enumerate(df_r.columns):
-                        v = rr[colname]
-                        ws.write(row, c, v, cell_f)
-                    row += 1
-                row += 1
+    def _entregar(fut, itens, locais):
+        if fut is not None and not ctx.get("pool_falhou"):
+            try:
+                res_lista, falhou = fut.result()
+            except Exception:
+                # Pool partido (worker morto, pickle, …): este e os seguintes em série.
+                ctx["pool_falhou"] = True
+            else:
+                calculados = iter(res_lista)
+                for (name, _d), (membros, zinfo, chave_c, pronto) in zip(itens, locais):
+                    if pronto is None:
+                        pronto = next(calculados, None)
+                        if pronto is None:
+                            break
+                        _garimpo_cache_ident_guardar(cache, chave_c, *pronto)
+                    yield name, membros, zinfo, pronto[0], pronto[1]
+                if falhou:
+                    raise RuntimeError(f"identify_xml_info falhou em {f_name}")
+                return
+        yield from _em_serie(itens, locais)
+
+    def _enviar(itens, locais):
+        a_identificar = [it for it, loc in zip(itens, locais) if loc[3] is None]
+        ctx["xml_lidos"] += len(a_identificar)
+        fut = None
+        pool = (
+            _garimpo_pool_obter(ctx)
+            if a_identificar and ctx["xml_lidos"] > _GARIM_IDENT_MIN_XML_PARA_POOL
+            else None
+        )
+        if pool is not None:
+            try:
+                fut = pool.submit(_garimpo_identificar_bloco_worker, cnpj_limpo, a_identificar)
+            except Exception:
+                ctx["pool_falhou"] = True
+        pendentes.append((fut, itens, locais))
 
-            tc = kpi.get("terc_cnt") or {}
-            if tc:
-                ws.merge_range(row, 0, row, 2, "Terceiros — quantidade por modelo", sub_f)
-                row += 1
-                ws.write(row, 0, "Modelo", hdr_f)
-                ws.write(row, 1, "Quantidade", hdr_f)
-                row += 1
-                for mod, q in sorted(tc.items(), key=lambda x: x[0]):
-                    ws.write(row, 0, mod, cell_f)
-                    ws.write(row, 1, int(q), cell_f)
-                    row += 1
+    bloco, locais = [], []
+    try:
+        try:
+            for name, xml_data, membros, zinfo in todos_xmls:
+                chave_c, pronto = _garimpo_cache_ident_obter(cache, cnpj_limpo, name, xml_data, zinfo)
+                bloco.append((name, xml_data if pronto is None else None))
+                locais.append((membros, zinfo, chave_c, pronto))
+                del xml_data
+                if len(bloco) < _GARIM_IDENT_BLOCO_XML:
+                    continue
+                _enviar(bloco, locais)
+                bloco, locais = [], []
+                while len(pendentes) > max_em_voo:
+                    yield from _entregar(*pendentes.popleft())
+        except Exception:
+            # Erro de leitura a meio da fonte: entrega o que já foi lido (como no modo série) e propaga.
+            while pendentes:
+                yield from _entregar(*pendentes.popleft())
+            yield from _em_serie(bloco, locais)
+            raise
+        if bloco:
+            if pendentes:
+                _enviar(bloco, locais)
+            else:
+                ctx["xml_lidos"] += sum(1 for loc in locais if loc[3] is None)
+                pendentes.append((None, bloco, locais))
+            bloco, locais = [], []
+        while pendentes:
+            yield from _entregar(*pendentes.popleft())
+    finally:
+        for fut, _i, _l in pendentes:
+            if fut is not None:
+                fut.cancel()
+        pendentes.clear()
 
-            ws.set_column(0, 0, 42)
-            ws.set_column(1, 1, 22)
 
-            if incluir_painel_fiscal:
-                _excel_escrever_painel_fiscal(wb, kpi, usados_nomes)
+# --- LIMPEZA DE PASTAS TEMPORÁRIAS ---
+def limpar_arquivos_temp():
+    """
+    Só limpa subpastas dedicadas da app — **nunca** apaga ficheiros na pasta de trabalho (cwd),
+    para não remover ZIP que o utilizador descarregou para a mesma pasta onde corre o Streamlit.
+    """
+    try:
+        if os.path.exists(TEMP_EXTRACT_DIR):
+            shutil.rmtree(TEMP_EXTRACT_DIR, ignore_errors=True)
 
-        return buf.getvalue()
-    except Exception as exc:
-        if not _erro_sem_espaco_disco(exc):
-            raise
-    return _excel_relatorio_geral_openpyxl_fallback_bytes(
-        df_g,
-        df_bur,
-        df_inu,
-        df_can,
-        df_aut,
-        df_den,
-        df_rej,
-        df_cte,
-        df_terc_rows,
-        omit_bur_inu=_omit_bur_inu,
-        kpi=kpi,
-        incluir_painel_fiscal=incluir_painel_fiscal,
-    )
+        if os.path.exists(TEMP_UPLOADS_DIR):
+            shutil.rmtree(TEMP_UPLOADS_DIR, ignore_errors=True)
+        _garimpo_limpar_fontes_xml_memoria_sessao()
+        _session_state_pop_garimpo(SESSION_KEY_GARIMPO_INDICE_LOTE)
+        try:
+            st.session_state.pop(SESSION_KEY_EXTRA_DIGESTS, None)
+        except Exception:
+            pass
+    except Exception:
+        pass
 
+# --- DIVISOR DE LOTES HTML (Para deixar botões organizados) ---
+def chunk_list(lst, n):
+    for i in range(0, len(lst), n): 
+        yield lst[i:i + n]
 
-def _pdf_ascii_seguro(txt):
-    if txt is None:
-        return ""
-    s = str(txt)
-    return (
-        unicodedata.normalize("NFKD", s).encode("ascii", "ignore").decode("ascii") or "-"
-    )
 
+def compactar_dataframe_memoria(df):
+    """Reduz uso de RAM (categorias + downcast); seguro para filtros .str / .isin."""
+    if df is None or df.empty:
+        return df
+    out = df.copy()
+    n = len(out)
+    for col in out.columns:
+        if out[col].dtype != object and not str(out[col].dtype).startswith("string"):
+            continue
+        nu = out[col].nunique(dropna=False)
+        if nu <= 1 or nu > min(4096, max(48, n // 2)):
+            continue
+        try:
+            out[col] = out[col].astype("category")
+        except (TypeError, ValueError):
+            pass
+    for col in out.select_dtypes(include=["float64"]).columns:
+        out[col] = pd.to_numeric(out[col], downcast="float")
+    for col in out.select_dtypes(include=["int64"]).columns:
+        out[col] = pd.to_numeric(out[col], downcast="integer")
+    return out
 
-def _pdf_txt(pdf, s, use_dejavu):
-    if use_dejavu:
-        return str(s)
-    return _pdf_ascii_seguro(s)
 
+# --- EXCEL EM FICHEIRO (livros grandes sem o livro inteiro na RAM) ---
+# Os relatórios saem para um .xlsx em disco e as folhas de dados são criadas em `constant_memory` do xlsxwriter:
+# cada linha vai para um ficheiro temporário quando a seguinte começa, em vez de todas as células ficarem em
+# objetos até ao fim. Nesse modo as linhas têm de ser escritas por ordem (o `to_excel` do pandas escreve coluna a
+# coluna), por isso as folhas de dados são escritas aqui linha a linha, em blocos. As folhas de layout
+# (Dashboard, Painel Fiscal: células fundidas em várias linhas, escritas por cartão) são pequenas e ficam no modo
+# normal — o xlsxwriter lê a opção ao criar cada folha. Folhas acima do limite do Excel (1 048 576 linhas com o
+# cabeçalho) partem-se em «Geral (1)», «Geral (2)»…
+# Quem recebe o caminho de um Excel temporário apaga-o com `_excel_fonte_descartar`; restos de exportações
+# interrompidas são varridos passadas 24 h.
+_EXCEL_MAX_LINHAS_DADOS = 1_048_575
+_EXCEL_BLOCO_LINHAS = 20_000
+_EXCEL_TEMP_TTL_SEG = 24 * 3600
+_EXCEL_OPCOES_LIVRO = {
+    "nan_inf_to_errors": True,
+    "remove_timezone": True,
+    "default_date_format": "yyyy-mm-dd hh:mm:ss",
+}
 
-def _pdf_font(pdf, use_dejavu, style="", size=10):
-    fam = "DejaVu" if use_dejavu else "Helvetica"
-    try:
-        pdf.set_font(fam, style, size)
-    except Exception:
-        if use_dejavu and style == "B":
-            try:
-                pdf.set_font("DejaVu", "", min(size + 1.4, 16))
-            except Exception:
-                pdf.set_font("Helvetica", "B", size)
-        else:
-            pdf.set_font("Helvetica", "" if not style else "B", size)
+
+def _excel_pasta_temp(varrer: bool = True) -> str:
+    d = os.path.join(_garimpo_spool_raiz(), "excel")
+    if not varrer:
+        return d
+    os.makedirs(d, exist_ok=True)
+    agora = time.time()
+    for ent in os.scandir(d):
+        try:
+            if ent.is_file() and agora - ent.stat().st_mtime > _EXCEL_TEMP_TTL_SEG:
+                os.remove(ent.path)
+        except OSError:
+            continue
+    return d
 
 
-def _pdf_multi_texto_largura_total(pdf, altura_linha, texto, use_dejavu):
+def _excel_caminho_temp(prefixo: str = "relatorio") -> str:
+    return os.path.join(_excel_pasta_temp(), f"{prefixo}_{os.getpid()}_{os.urandom(6).hex()}.xlsx")
+
+
+def _excel_fonte_e_ficheiro(xb) -> bool:
+    """True se `xb` for o caminho de um .xlsx (das funções `..._ficheiro`) e não os bytes do livro."""
+    return isinstance(xb, (str, os.PathLike))
+
+
+def _excel_fonte_e_temporaria(xb) -> bool:
+    """True se `xb` for um ficheiro de `_excel_pasta_temp` (a apagar por quem o consome)."""
+    if not _excel_fonte_e_ficheiro(xb):
+        return False
+    return os.path.dirname(os.path.abspath(xb)) == os.path.abspath(_excel_pasta_temp(varrer=False))
+
+
+def _excel_fonte_descartar(xb) -> None:
     """
-    Texto em bloco na largura útil da página.
-    Evita FPDFException (fpdf2): multi_cell(0, ...) com get_x() à direita — largura útil ~0.
+    Apaga o .xlsx temporário de uma função `..._ficheiro`. Bytes e ficheiros fora de `_excel_pasta_temp`
+    (cache de relatórios, destino indicado por quem chamou) ficam.
     """
-    pdf.set_x(pdf.l_margin)
-    w = max(30.0, pdf.w - pdf.l_margin - pdf.r_margin)
-    pdf.multi_cell(w, altura_linha, _pdf_txt(pdf, texto, use_dejavu))
+    if not _excel_fonte_e_temporaria(xb):
+        return
+    try:
+        os.remove(xb)
+    except OSError:
+        pass
 
 
-def _pdf_cabecalho_executivo_painel(pdf, use_dejavu, linha_extra=None):
-    """Cabeçalho alinhado ao painel da app: off-white, texto vinho."""
-    y = pdf.get_y()
-    w = pdf.w - pdf.l_margin - pdf.r_margin
-    h = 20.0
-    pdf.set_fill_color(253, 251, 247)
-    pdf.set_draw_color(220, 210, 200)
-    pdf.set_line_width(0.25)
-    pdf.rect(pdf.l_margin, y, w, h, "DF")
-    _pdf_font(pdf, use_dejavu, "B", 12)
-    pdf.set_text_color(93, 27, 54)
-    pdf.set_xy(pdf.l_margin + 4, y + 3.5)
-    pdf.cell(w - 8, 6, _pdf_txt(pdf, "GARIMPEIRO · PAINEL DO LOTE", use_dejavu), ln=False)
-    _pdf_font(pdf, use_dejavu, "", 7.5)
-    pdf.set_text_color(90, 75, 85)
-    sub = "Boutique de dados · mesmo desenho que na página principal do Garimpeiro."
-    if linha_extra:
-        sub = f"{linha_extra} · {sub}"
-    pdf.set_xy(pdf.l_margin + 4, y + 10)
-    pdf.cell(w - 8, 4.5, _pdf_txt(pdf, sub, use_dejavu), ln=False)
-    dt = datetime.now().strftime("%d/%m/%Y · %H:%M")
-    _pdf_font(pdf, use_dejavu, "", 6.5)
-    pdf.set_text_color(130, 115, 125)
-    pdf.set_xy(pdf.l_margin + 4, y + 15)
-    pdf.cell(w - 8, 4, _pdf_txt(pdf, dt, use_dejavu), ln=False)
-    pdf.set_text_color(32, 35, 42)
-    pdf.set_xy(pdf.l_margin, y + h + 3)
+def _excel_fonte_gravar(xb, destino) -> None:
+    """Grava o Excel (bytes, ou caminho — copiado sem passar pela memória) em `destino`."""
+    if _excel_fonte_e_ficheiro(xb):
+        shutil.copyfile(xb, destino)
+        return
+    with open(destino, "wb") as f:
+        f.write(xb if isinstance(xb, (bytes, bytearray)) else bytes(xb))
 
 
-def _pdf_quatro_kpi_cards_executivo(pdf, kpi, use_dejavu):
-    """Quatro cartões KPI como no Streamlit / Excel (borda #A1869E, fundo branco)."""
-    pm = dict(kpi.get("pares") or [])
-    try:
-        n_prop = int(pm.get("XML emissão própria (itens)", 0) or 0)
-    except (TypeError, ValueError):
-        n_prop = 0
-    try:
-        n_terc_xml = int(pm.get("XML terceiros (itens)", 0) or 0)
-    except (TypeError, ValueError):
-        n_terc_xml = 0
-    n_docs = int(kpi.get("n_docs") or 0)
-    sc = kpi.get("sc") or {}
-    aut = int(sc.get("AUTORIZADAS", 0) or 0)
-    can = int(sc.get("CANCELADOS", 0) or 0)
-    inu = int(sc.get("INUTILIZADOS", 0) or 0)
-    valor = float(kpi.get("valor") or 0.0)
-    terc_cnt = kpi.get("terc_cnt") or {}
-    if not isinstance(terc_cnt, dict):
-        terc_cnt = {}
-    terc_linhas = []
+def _zip_escrever_excel(zf, nome: str, xb) -> None:
+    """`writestr` para bytes; de um caminho o zipfile comprime o ficheiro por blocos."""
+    if _excel_fonte_e_ficheiro(xb):
+        zf.write(os.fspath(xb), nome)
+    else:
+        zf.writestr(nome, xb)
+
+
+def _excel_ficheiro_para_bytes(caminho):
+    """Lê o ficheiro (e apaga-o se for temporário) para `st.download_button` e quem ainda trabalha com bytes."""
+    if not caminho:
+        return None
     try:
-        itens = sorted(terc_cnt.items(), key=lambda x: int(x[1] or 0), reverse=True)
-        for mod, q in itens[:2]:
-            terc_linhas.append(f"{str(mod).strip()}: {_excel_fmt_milhar_pt(int(q or 0))}")
-    except Exception:
-        terc_linhas = []
-    if not terc_linhas:
-        terc_linhas = ["—"]
+        with open(caminho, "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+    finally:
+        _excel_fonte_descartar(caminho)
 
-    specs = [
-        (
-            "TOTAL DE DOCUMENTOS\nLIDOS (N.º GERAL)",
-            _excel_fmt_milhar_pt(n_docs),
-            f"Próprios: {_excel_fmt_milhar_pt(n_prop)}\nTerceiros: {_excel_fmt_milhar_pt(n_terc_xml)}",
-        ),
-        (
-            "DETALHAMENTO\nEMISSÃO PRÓPRIA",
-            f"{_excel_fmt_milhar_pt(aut)} Aut.",
-            f"Canceladas: {_excel_fmt_milhar_pt(can)}\nInutilizadas: {_excel_fmt_milhar_pt(inu)}",
-        ),
-        (
-            "DETALHAMENTO\nDOCUMENTOS TERCEIROS",
-            f"{_excel_fmt_milhar_pt(n_terc_xml)} Terc.",
-            "\n".join(terc_linhas),
-        ),
-        (
-            "VOLUME\nFINANCEIRO",
-            _excel_fmt_reais_pt_str(valor),
-            "Soma do valor contábil no resumo por série",
-        ),
-    ]
 
-    margin = pdf.l_margin
-    full = pdf.w - margin - pdf.r_margin
-    gap = 2.4
-    ncols = 4
-    cw = (full - gap * (ncols - 1)) / ncols
-    y0 = pdf.get_y()
-    card_h = 38.0
-    title_h = 10.5
-    foot_h = 12.0
-    val_h = card_h - title_h - foot_h
-    bor = (161, 134, 158)
-    sep = (210, 195, 205)
+def _excel_valores_coluna(s: pd.Series) -> list:
+    """Valores Python de uma coluna para `write_row` (vazios → None, como o `na_rep=""` do `to_excel`)."""
+    v = s.astype(object)
+    return v.where(s.notna().to_numpy(), None).tolist()
 
-    pdf.set_line_width(0.45)
-    for i, (tit, val, foot) in enumerate(specs):
-        x = margin + i * (cw + gap)
-        pdf.set_fill_color(255, 255, 255)
-        pdf.set_draw_color(*bor)
-        pdf.rect(x, y0, cw, card_h, "D")
-        pdf.set_draw_color(*sep)
-        pdf.set_line_width(0.15)
-        pdf.line(x, y0 + title_h, x + cw, y0 + title_h)
-        pdf.line(x, y0 + title_h + val_h, x + cw, y0 + title_h + val_h)
-        pdf.set_line_width(0.45)
 
-        _pdf_font(pdf, use_dejavu, "B", 5.8)
-        pdf.set_text_color(32, 35, 42)
-        yl = y0 + 2.2
-        for part in str(tit).split("\n")[:2]:
-            pdf.set_xy(x + 1.5, yl)
-            pdf.cell(cw - 3, 3.4, _pdf_txt(pdf, part.strip(), use_dejavu), align="C", ln=False)
-            yl += 3.5
+def _excel_folha_df_linhas(wb, df, nome_desejado, usados) -> None:
+    """
+    `_excel_escrever_folha_df` em folhas `constant_memory`: cabeçalho (no estilo do pandas) e linhas por ordem,
+    em blocos de `_EXCEL_BLOCO_LINHAS`. Acima de `_EXCEL_MAX_LINHAS_DADOS` linhas parte em «Nome (1)»,
+    «Nome (2)»…
+    """
+    if df is None:
+        d = pd.DataFrame({"Nota": ["Sem dados nesta vista."]})
+    elif df.empty and len(df.columns) == 0:
+        d = pd.DataFrame({"Nota": ["Sem registos nesta vista."]})
+    else:
+        d = df
+    fmt_cab = wb.add_format(
+        {"bold": True, "top": 1, "bottom": 1, "left": 1, "right": 1, "align": "center", "valign": "top"}
+    )
+    cabecalho = [str(c) for c in d.columns]
+    n = len(d)
+    n_partes = max(1, -(-n // _EXCEL_MAX_LINHAS_DADOS))
+    for parte in range(n_partes):
+        nome = nome_desejado if n_partes == 1 else f"{nome_desejado} ({parte + 1})"
+        wb.constant_memory = True
+        try:
+            ws = wb.add_worksheet(_excel_nome_folha_seguro(nome, usados))
+        finally:
+            wb.constant_memory = False
+        ws.write_row(0, 0, cabecalho, fmt_cab)
+        ini = parte * _EXCEL_MAX_LINHAS_DADOS
+        fim = min(n, ini + _EXCEL_MAX_LINHAS_DADOS)
+        r = 1
+        for a in range(ini, fim, _EXCEL_BLOCO_LINHAS):
+            bloco = d.iloc[a : min(fim, a + _EXCEL_BLOCO_LINHAS)]
+            for linha in zip(*(_excel_valores_coluna(bloco.iloc[:, j]) for j in range(bloco.shape[1]))):
+                ws.write_row(r, 0, linha)
+                r += 1
+
+
+def _excel_gravar_livro(caminho, escrever, alternativa=None):
+    """
+    Escreve um livro xlsxwriter com `escrever(wb)` para `caminho` (via `.parcial`); os temporários das folhas
+    `constant_memory` ficam em `_excel_pasta_temp`.
+    Em disco/temp cheio (errno 28) grava `alternativa()` (bytes, ex.: openpyxl) se houver; outros erros
+    propagam-se. Devolve o caminho, ou None se nada ficou gravado.
+    """
+    caminho = os.fspath(caminho)
+    tmp = caminho + ".parcial"
+    try:
+        with open(tmp, "wb") as fh:
+            opcoes = dict(_EXCEL_OPCOES_LIVRO, tmpdir=_excel_pasta_temp())
+            with pd.ExcelWriter(fh, engine="xlsxwriter", engine_kwargs={"options": opcoes}) as writer:
+                escrever(writer.book)
+        os.replace(tmp, caminho)
+        return caminho
+    except Exception as exc:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        if not _erro_sem_espaco_disco(exc):
+            raise
+    xb = alternativa() if alternativa is not None else None
+    if not xb:
+        return None
+    try:
+        _excel_fonte_gravar(xb, caminho)
+        return caminho
+    except OSError:
+        _excel_fonte_descartar(caminho)
+        return None
 
-        _pdf_font(pdf, use_dejavu, "B", 9.5 if len(val) < 14 else 8.0)
-        pdf.set_text_color(32, 35, 42)
-        pdf.set_xy(x + 1.5, y0 + title_h + 3.5)
-        pdf.cell(cw - 3, val_h - 4, _pdf_txt(pdf, val, use_dejavu), align="C", ln=False)
 
-        _pdf_font(pdf, use_dejavu, "", 5.6)
-        pdf.set_text_color(61, 53, 64)
-        yf = y0 + title_h + val_h + 2.0
-        for fl in str(foot).split("\n")[:3]:
-            pdf.set_xy(x + 1.5, yf)
-            pdf.cell(cw - 3, 3.2, _pdf_txt(pdf, fl.strip(), use_dejavu), align="C", ln=False)
-            yf += 3.25
+def dataframe_para_excel_ficheiro(df, sheet_name="Dados", caminho=None):
+    """
+    Excel com as mesmas colunas do DataFrame, gravado em `caminho` (omissão: temporário em `_excel_pasta_temp`).
+    Em disco/temp cheio (errno 28) tenta openpyxl; em falha total devolve None.
+    """
+    if df is None or df.empty:
+        return None
+    sn = (sheet_name or "Dados")[:31]
+    dfx = df.reset_index(drop=True)
 
-    pdf.set_xy(pdf.l_margin, y0 + card_h + 4)
+    def _openpyxl():
+        try:
+            buf2 = io.BytesIO()
+            with pd.ExcelWriter(buf2, engine="openpyxl") as writer:
+                dfx.to_excel(writer, sheet_name=sn, index=False)
+            return buf2.getvalue()
+        except Exception:
+            return None
 
+    return _excel_gravar_livro(
+        caminho or _excel_caminho_temp("tabela"),
+        lambda wb: _excel_folha_df_linhas(wb, dfx, sn, set()),
+        _openpyxl,
+    )
 
-def _pdf_faixa_buracos_executivo(pdf, n_bur, use_dejavu):
-    """Uma linha de contexto: buracos (saiu do antigo quadro 2Ã—2)."""
-    margin = pdf.l_margin
-    full = pdf.w - margin - pdf.r_margin
-    y = pdf.get_y()
-    h = 7.5
-    pdf.set_fill_color(255, 255, 255)
-    pdf.set_draw_color(161, 134, 158)
-    pdf.set_line_width(0.2)
-    pdf.rect(margin, y, full, h, "D")
-    _pdf_font(pdf, use_dejavu, "", 7)
-    pdf.set_text_color(93, 27, 54)
-    pdf.set_xy(margin + 3, y + 2)
-    pdf.cell(
-        full - 6,
-        4,
-        _pdf_txt(
-            pdf,
-            f"Buracos na sequência (emissão própria): {_excel_fmt_milhar_pt(int(n_bur or 0))}",
-            use_dejavu,
-        ),
-        ln=False,
-    )
-    pdf.set_xy(pdf.l_margin, y + h + 3)
 
+def dataframe_para_excel_bytes(df, sheet_name="Dados"):
+    """
+    Excel com as mesmas colunas do DataFrame (para download alinhado à tabela na tela).
+    Em disco/temp cheio (errno 28) tenta openpyxl; em falha total devolve None.
+    """
+    return _excel_ficheiro_para_bytes(dataframe_para_excel_ficheiro(df, sheet_name))
 
-def _pdf_serie_cards_emissao_propria(pdf, df_resumo, use_dejavu):
-    """CartÃµes no mesmo padrÃ£o dos KPI: cada sÃ©rie da emissÃ£o prÃ³pria com faixa inicialâ€“final."""
-    pdf.ln(1)
-    _pdf_font(pdf, use_dejavu, "B", 9)
-    pdf.set_text_color(93, 27, 54)
-    pdf.set_x(pdf.l_margin)
-    pdf.cell(0, 5, _pdf_txt(pdf, "Emissão própria — séries e faixas de numeração", use_dejavu), ln=True)
-    _pdf_font(pdf, use_dejavu, "", 7)
-    pdf.set_text_color(90, 75, 85)
-    pdf.set_x(pdf.l_margin)
-    pdf.cell(
-        0,
-        4,
-        _pdf_txt(
-            pdf,
-            "Um cartão por modelo e série: menor e maior número de nota encontrados nos ficheiros XML do lote.",
-            use_dejavu,
-        ),
-        ln=True,
-    )
-    pdf.ln(1.5)
-
-    if df_resumo is None or not isinstance(df_resumo, pd.DataFrame) or df_resumo.empty:
-        _pdf_font(pdf, use_dejavu, "", 8)
-        pdf.set_text_color(130, 115, 125)
-        pdf.set_x(pdf.l_margin)
-        pdf.cell(0, 5, _pdf_txt(pdf, "Sem linhas no resumo por série.", use_dejavu), ln=True)
-        pdf.ln(2)
-        return
 
-    doc_col = "Documento" if "Documento" in df_resumo.columns else None
-    ser_col = "Série" if "Série" in df_resumo.columns else ("Serie" if "Serie" in df_resumo.columns else None)
-    if not doc_col or not ser_col:
-        _pdf_font(pdf, use_dejavu, "", 8)
-        pdf.set_text_color(180, 90, 90)
-        pdf.set_x(pdf.l_margin)
-        pdf.cell(
-            0,
-            5,
-            _pdf_txt(pdf, "Resumo sem colunas Documento/Série — cartões não gerados.", use_dejavu),
-            ln=True,
-        )
-        pdf.ln(2)
-        return
+# Limites de linhas por tabela no PDF do dashboard (evita ficheiros gigantes).
+_DASH_PDF_MAX = {"resumo": 100, "tabela": 90, "geral": 75}
+# Colunas preferidas no relatório geral no PDF (espelho legível da página da app).
+_DASH_PDF_GERAL_COLS = [
+    "Modelo",
+    "Série",
+    "Nota",
+    "Data Emissão",
+    "Status Final",
+    "Valor",
+    "Origem",
+    "Chave",
+]
 
-    ini_col = "Início" if "Início" in df_resumo.columns else ("Inicio" if "Inicio" in df_resumo.columns else None)
-    fim_col = "Fim" if "Fim" in df_resumo.columns else None
-    qtd_col = "Quantidade" if "Quantidade" in df_resumo.columns else None
-    val_col = "Valor Contábil (R$)" if "Valor Contábil (R$)" in df_resumo.columns else None
 
-    margin = pdf.l_margin
-    full = pdf.w - margin - pdf.r_margin
-    gap_h = 2.4
-    gap_v = 2.8
-    ncols = 2
-    cw = (full - gap_h * (ncols - 1)) / ncols
-    card_h = 35.0
-    title_h = 10.0
-    foot_h = 10.5
-    val_h = card_h - title_h - foot_h
-    bor = (161, 134, 158)
-    sep = (210, 195, 205)
+def _format_celula_pdf_col(nome_col, val):
+    if val is None:
+        return "-"
+    try:
+        if pd.isna(val):
+            return "-"
+    except (TypeError, ValueError):
+        pass
+    nome = str(nome_col).strip().lower()
+    nome_sem_acento = "".join(
+        ch for ch in unicodedata.normalize("NFD", nome) if unicodedata.category(ch) != "Mn"
+    )
+    if "data" in nome_sem_acento and "emiss" in nome_sem_acento:
+        f = _valor_data_emissao_dd_mm_yyyy(val)
+        return f if f else "-"
+    s = str(val).strip()
+    if nome == "chave" and len(s) > 18:
+        return f"...{s[-14:]}"
+    if len(s) > 48:
+        return s[:45] + "..."
+    return s
 
-    recs = [row for _, row in df_resumo.iterrows()]
-    idx = 0
-    while idx < len(recs):
-        y0 = pdf.get_y()
-        if y0 + card_h > 275:
-            pdf.add_page()
-            y0 = pdf.get_y()
-        for col in range(ncols):
-            if idx >= len(recs):
-                break
-            row = recs[idx]
-            x = margin + col * (cw + gap_h)
-            doc = str(row.get(doc_col, "") or "").strip()
-            ser = str(row.get(ser_col, "") or "").strip()
-            if len(doc) > 24:
-                doc = doc[:22] + "…"
-            tit_a = doc if doc else "—"
-            tit_b = f"Série {ser}" if ser else "Série —"
-            ini = row.get(ini_col, "") if ini_col else ""
-            fim = row.get(fim_col, "") if fim_col else ""
-            foot_lines = []
-            if qtd_col is not None and row.get(qtd_col, "") != "" and str(row.get(qtd_col)).strip() != "":
-                try:
-                    qv = int(row[qtd_col])
-                    foot_lines.append(f"Quantidade: {_excel_fmt_milhar_pt(qv)}")
-                except (TypeError, ValueError):
-                    foot_lines.append(f"Quantidade: {row.get(qtd_col)}")
-            if val_col is not None:
-                try:
-                    vv = float(row[val_col])
-                    foot_lines.append(_excel_fmt_reais_pt_str(vv))
-                except (TypeError, ValueError):
-                    pass
 
-            pdf.set_line_width(0.45)
-            pdf.set_fill_color(255, 255, 255)
-            pdf.set_draw_color(*bor)
-            pdf.rect(x, y0, cw, card_h, "D")
-            pdf.set_draw_color(*sep)
-            pdf.set_line_width(0.15)
-            pdf.line(x, y0 + title_h, x + cw, y0 + title_h)
-            pdf.line(x, y0 + title_h + val_h, x + cw, y0 + title_h + val_h)
-            pdf.set_line_width(0.45)
+def _preview_df_para_pdf(df, max_rows, colunas_preferidas=None, msg_se_vazio=None):
+    """
+    Prepara cabeçalhos e linhas para desenhar tabela no PDF.
+    Retorno: cols, rows (listas de str), total, truncated, empty_msg opcional.
+    """
+    if df is None or df.empty:
+        return {
+            "cols": [],
+            "rows": [],
+            "total": 0,
+            "truncated": False,
+            "empty_msg": msg_se_vazio,
+        }
+    d = df.reset_index(drop=True)
+    if colunas_preferidas:
+        existentes = [c for c in colunas_preferidas if c in d.columns]
+        if existentes:
+            d = d[existentes]
+        # se nenhuma coluna preferida existir, usa todas
+        elif not existentes:
+            pass
+    cols = [str(c) for c in d.columns]
+    total = len(d)
+    truncated = total > max_rows
+    sub = d.head(max_rows)
+    rows = []
+    for _, r in sub.iterrows():
+        rows.append([_format_celula_pdf_col(c, r[c]) for c in d.columns])
+    return {"cols": cols, "rows": rows, "total": total, "truncated": truncated, "empty_msg": None}
 
-            _pdf_font(pdf, use_dejavu, "B", 6.5)
-            pdf.set_text_color(32, 35, 42)
-            yl = y0 + 2.0
-            pdf.set_xy(x + 1.5, yl)
-            pdf.cell(cw - 3, 3.3, _pdf_txt(pdf, tit_a, use_dejavu), align="C", ln=False)
-            yl += 3.5
-            pdf.set_xy(x + 1.5, yl)
-            pdf.cell(cw - 3, 3.3, _pdf_txt(pdf, tit_b, use_dejavu), align="C", ln=False)
 
-            inner_w = cw - 3.0
-            gutter = 1.2
-            half_w = (inner_w - gutter) / 2.0
-            x_left = x + 1.5
-            x_right = x + 1.5 + half_w + gutter
-            def _pdf_val_nota_intervalo(v):
-                if v is None or (isinstance(v, float) and pd.isna(v)):
-                    return ""
-                s = str(v).strip()
-                return "" if not s or s.lower() == "nan" else s
+def _preview_terceiros_para_pdf(terc_cnt):
+    if not terc_cnt:
+        return {
+            "cols": [],
+            "rows": [],
+            "total": 0,
+            "truncated": False,
+            "empty_msg": "Nenhum XML de terceiros no lote.",
+        }
+    rows = [[str(m), str(int(q))] for m, q in sorted(terc_cnt.items(), key=lambda x: x[0])]
+    return {
+        "cols": ["Modelo", "Quantidade"],
+        "rows": rows,
+        "total": len(rows),
+        "truncated": False,
+        "empty_msg": None,
+    }
 
-            ini_s = _pdf_val_nota_intervalo(ini)
-            fim_s = _pdf_val_nota_intervalo(fim)
-            if not ini_s and not fim_s:
-                ini_s, fim_s = "—", "—"
-            elif not ini_s:
-                ini_s = "—"
-            elif not fim_s:
-                fim_s = "—"
-            fs_ini = 11.0 if len(ini_s) < 11 else (9.0 if len(ini_s) < 16 else 7.5)
-            fs_fim = 11.0 if len(fim_s) < 11 else (9.0 if len(fim_s) < 16 else 7.5)
-            y_mid = y0 + title_h
-            y_num = y_mid + 2.8
-            h_num_cell = 6.8
-            _pdf_font(pdf, use_dejavu, "B", fs_ini)
-            pdf.set_text_color(32, 35, 42)
-            pdf.set_xy(x_left, y_num)
-            pdf.cell(half_w, h_num_cell, _pdf_txt(pdf, ini_s, use_dejavu), align="C", ln=False)
-            _pdf_font(pdf, use_dejavu, "B", fs_fim)
-            pdf.set_xy(x_right, y_num)
-            pdf.cell(half_w, h_num_cell, _pdf_txt(pdf, fim_s, use_dejavu), align="C", ln=False)
-            _pdf_font(pdf, use_dejavu, "", 5.5)
-            pdf.set_text_color(90, 75, 85)
-            y_lbl = y_num + h_num_cell + 0.5
-            pdf.set_xy(x_left, y_lbl)
-            pdf.cell(half_w, 3.2, _pdf_txt(pdf, "Inicial", use_dejavu), align="C", ln=False)
-            pdf.set_xy(x_right, y_lbl)
-            pdf.cell(half_w, 3.2, _pdf_txt(pdf, "Final", use_dejavu), align="C", ln=False)
 
-            _pdf_font(pdf, use_dejavu, "", 5.8)
-            pdf.set_text_color(61, 53, 64)
-            yf = y0 + title_h + val_h + 1.8
-            for fl in foot_lines[:2]:
-                if not str(fl).strip():
-                    continue
-                pdf.set_xy(x + 1.5, yf)
-                pdf.cell(cw - 3, 3.0, _pdf_txt(pdf, fl, use_dejavu), align="C", ln=False)
-                yf += 3.05
+def coletar_kpis_dashboard():
+    """Indicadores agregados para dashboard na app, Excel (folha Dashboard) e PDF."""
+    rel = st.session_state.get("relatorio") or []
+    pares = _relatorio_contagem_pares(rel, "Pasta", "Tipo")
+    sc = st.session_state.get("st_counts") or {}
+    df_g = st.session_state.get("df_geral")
+    df_r = st.session_state.get("df_resumo")
+    df_f = st.session_state.get("df_faltantes")
+    n_geral = len(df_g) if df_g is not None and not df_g.empty else 0
+    n_bur = len(df_f) if df_f is not None and not df_f.empty else 0
+    n_proprios = sum(q for (pasta, _t), q in pares.items() if "EMITIDOS_CLIENTE" in (pasta or ""))
+    n_terc = 0
+    terc_cnt = Counter()
+    for (pasta, tipo), q in pares.items():
+        if "RECEBIDOS_TERCEIROS" in (pasta or ""):
+            n_terc += q
+            terc_cnt[tipo or "Outros"] += q
+    valor = 0.0
+    if df_r is not None and not df_r.empty and "Valor Contábil (R$)" in df_r.columns:
+        try:
+            valor = float(df_r["Valor Contábil (R$)"].sum())
+        except (TypeError, ValueError):
+            valor = 0.0
+    status_dist = {}
+    if df_g is not None and not df_g.empty and "Status Final" in df_g.columns:
+        vc = df_g["Status Final"].value_counts()
+        status_dist = {str(k): int(v) for k, v in vc.items()}
+    terc_status_dist = {}
+    if (
+        df_g is not None
+        and not df_g.empty
+        and "Origem" in df_g.columns
+        and "Status Final" in df_g.columns
+    ):
+        _m_terc = df_g["Origem"].astype(str).str.contains("TERCEIROS", case=False, na=False)
+        if _m_terc.any():
+            _vc_terc = df_g.loc[_m_terc, "Status Final"].value_counts()
+            terc_status_dist = {str(k): int(v) for k, v in _vc_terc.items()}
+    ref_ok = bool(st.session_state.get("seq_ref_ultimos"))
+    val_ok = bool(st.session_state.get("validation_done"))
+    pares = [
+        ("Gerado em", datetime.now().strftime("%d/%m/%Y %H:%M")),
+        ("Linhas no relatório geral", n_geral),
+        ("Itens no lote (relatório bruto)", _relatorio_len(rel)),
+        ("Autorizadas (emissão própria)", int(sc.get("AUTORIZADAS", 0) or 0)),
+        ("Canceladas (emissão própria)", int(sc.get("CANCELADOS", 0) or 0)),
+        ("Denegadas (emissão própria)", int(sc.get("DENEGADOS", 0) or 0)),
+        ("Rejeitadas (emissão própria)", int(sc.get("REJEITADOS", 0) or 0)),
+        ("Inutilizadas (emissão própria)", int(sc.get("INUTILIZADOS", 0) or 0)),
+        ("Buracos na sequência", n_bur),
+        ("XML emissão própria (itens)", n_proprios),
+        ("XML terceiros (itens)", n_terc),
+        ("Valor contábil — resumo séries (R$)", _excel_fmt_reais_pt_str(valor)),
+        ("Referência último nº guardada", "Sim" if ref_ok else "Não"),
+        ("Validação autenticidade", "Sim" if val_ok else "Não"),
+    ]
+    df_inu = st.session_state.get("df_inutilizadas")
+    df_can = st.session_state.get("df_canceladas")
+    df_aut = st.session_state.get("df_autorizadas")
+    df_den = st.session_state.get("df_denegadas")
+    df_rej = st.session_state.get("df_rejeitadas")
+    df_g_pdf_geral = df_g
+    if df_g is not None and not df_g.empty and "Origem" in df_g.columns:
+        df_g_pdf_geral = df_g.loc[_mask_emissao_propria_df(df_g)].reset_index(drop=True)
+    pdf_previews = {
+        "resumo": _preview_df_para_pdf(
+            df_r,
+            _DASH_PDF_MAX["resumo"],
+            msg_se_vazio="Sem linhas no resumo por série.",
+        ),
+        "terceiros": _preview_terceiros_para_pdf(dict(terc_cnt)),
+        "buracos": _preview_df_para_pdf(
+            df_f,
+            _DASH_PDF_MAX["tabela"],
+            msg_se_vazio="Tudo em ordem — nenhum buraco na auditoria.",
+        ),
+        "inutilizadas": _preview_df_para_pdf(
+            df_inu,
+            _DASH_PDF_MAX["tabela"],
+            msg_se_vazio="Nenhuma inutilizada listada neste detalhe.",
+        ),
+        "canceladas": _preview_df_para_pdf(
+            df_can,
+            _DASH_PDF_MAX["tabela"],
+            msg_se_vazio="Nenhuma cancelada listada neste detalhe.",
+        ),
+        "autorizadas": _preview_df_para_pdf(
+            df_aut,
+            _DASH_PDF_MAX["tabela"],
+            msg_se_vazio="Nenhuma autorizada listada neste detalhe.",
+        ),
+        "denegadas": _preview_df_para_pdf(
+            df_den,
+            _DASH_PDF_MAX["tabela"],
+            msg_se_vazio="Nenhuma denegada listada neste detalhe.",
+        ),
+        "rejeitadas": _preview_df_para_pdf(
+            df_rej,
+            _DASH_PDF_MAX["tabela"],
+            msg_se_vazio="Nenhuma rejeitada listada neste detalhe.",
+        ),
+        "geral": _preview_df_para_pdf(
+            df_g_pdf_geral,
+            _DASH_PDF_MAX["geral"],
+            _DASH_PDF_GERAL_COLS,
+            msg_se_vazio="Relatório geral vazio (emissão própria).",
+        ),
+    }
+    return {
+        "pares": pares,
+        "n_geral": n_geral,
+        "n_bur": n_bur,
+        "n_terc": n_terc,
+        "n_docs": _relatorio_len(rel),
+        "valor": valor,
+        "status_dist": status_dist,
+        "terc_cnt": dict(terc_cnt),
+        "terc_status_dist": terc_status_dist,
+        "sc": sc,
+        "pdf_previews": pdf_previews,
+    }
 
-            idx += 1
-        pdf.set_xy(margin, y0 + card_h + gap_v)
 
-    pdf.ln(1)
+def _excel_nome_folha_seguro(nome, usados):
+    """Nomes de folha Excel: máx. 31 caracteres; sem \\ / * ? : [ ]."""
+    inv = frozenset('[]:*?/\\')
+    base = "".join(c for c in str(nome) if c not in inv).strip()[:31] or "Sheet"
+    out = base
+    k = 2
+    while out in usados:
+        suf = f" ({k})"
+        out = (base[: max(1, 31 - len(suf))] + suf).strip()
+        k += 1
+    usados.add(out)
+    return out
 
 
-def _pdf_lista_rosa(pdf, titulo, pares, use_dejavu, subtitulo=None):
-    """Lista rÃ³tulo â†’ número com linhas em grelha suave (folha 1, como no PDF de referência)."""
-    if not pares:
+def _excel_escrever_folha_df(writer, df, nome_desejado, usados):
+    """Escreve um DataFrame na folha; se vazio, cabeçalhos ou nota curta."""
+    sn = _excel_nome_folha_seguro(nome_desejado, usados)
+    if df is None:
+        pd.DataFrame({"Nota": ["Sem dados nesta vista."]}).to_excel(
+            writer, sheet_name=sn, index=False
+        )
         return
-    pdf.ln(2)
-    _pdf_font(pdf, use_dejavu, "B", 9)
-    pdf.set_text_color(173, 20, 87)
-    pdf.set_x(pdf.l_margin)
-    pdf.cell(0, 5, _pdf_txt(pdf, titulo, use_dejavu), ln=True)
-    if subtitulo:
-        _pdf_font(pdf, use_dejavu, "", 7)
-        pdf.set_text_color(130, 85, 115)
-        _pdf_multi_texto_largura_total(pdf, 3.5, subtitulo, use_dejavu)
-    pdf.ln(1)
-    full = pdf.w - pdf.l_margin - pdf.r_margin
-    row_h = 6
-    for lab, val in pares:
-        if pdf.get_y() > 268:
-            pdf.add_page()
-        y = pdf.get_y()
-        pdf.set_fill_color(255, 252, 254)
-        pdf.set_draw_color(255, 192, 216)
-        pdf.rect(pdf.l_margin, y, full, row_h, "D")
-        _pdf_font(pdf, use_dejavu, "", 8)
-        pdf.set_text_color(95, 55, 80)
-        pdf.set_xy(pdf.l_margin + 3, y + 1.3)
-        pdf.cell(full * 0.62, row_h - 2, _pdf_txt(pdf, str(lab), use_dejavu), ln=False)
-        _pdf_font(pdf, use_dejavu, "B", 9.5)
-        pdf.set_text_color(199, 21, 133)
-        pdf.set_xy(pdf.l_margin + full * 0.65, y + 1)
-        pdf.cell(full * 0.32, row_h - 2, _pdf_txt(pdf, str(val), use_dejavu), ln=False, align="R")
-        pdf.set_xy(pdf.l_margin, y + row_h)
-    pdf.ln(0.5)
-
-
-def _pdf_extras_lote_lista_rosa(pdf, kpi, use_dejavu):
-    """Linhas do relatório geral, valor, XML próprio/terceiro — lista simples."""
-    pm = dict(kpi.get("pares") or [])
-    val = float(kpi.get("valor") or 0)
-    val_txt = _excel_fmt_reais_pt_str(val)
-    itens = []
-    if "Linhas no relatório geral" in pm:
-        itens.append(("Linhas no relatório geral (expandido)", str(pm["Linhas no relatório geral"])))
-    itens.append(("Valor contábil no resumo por série", val_txt))
-    if "XML emissão própria (itens)" in pm:
-        itens.append(("XML emissão própria", str(pm["XML emissão própria (itens)"])))
-    if "XML terceiros (itens)" in pm:
-        itens.append(("XML terceiros", str(pm["XML terceiros (itens)"])))
-    _pdf_lista_rosa(
-        pdf,
-        "Mais números do lote",
-        itens,
-        use_dejavu,
-        subtitulo="Complemento aos totalizadores acima (sem gráficos — só contagem neste garimpo).",
-    )
+    d = df.reset_index(drop=True)
+    if d.empty:
+        if len(d.columns) > 0:
+            d.to_excel(writer, sheet_name=sn, index=False)
+        else:
+            pd.DataFrame({"Nota": ["Sem registos nesta vista."]}).to_excel(
+                writer, sheet_name=sn, index=False
+            )
+    else:
+        d.to_excel(writer, sheet_name=sn, index=False)
 
 
-def _pdf_contexto_lista_rosa(pdf, pares_lista, use_dejavu):
-    """Referência lateral, autenticidade, gerado em — estilo suave."""
-    pm = dict(pares_lista or [])
-    rotulos = [
-        ("Gerado em", "Gerado em"),
-        ("Referência último nº guardada", "Último nº por série (lateral)"),
-        ("Validação autenticidade", "Autenticidade"),
-    ]
-    itens = [(c, pm[k]) for k, c in rotulos if k in pm]
-    if not itens:
-        return
-    _pdf_lista_rosa(
-        pdf,
-        "Contexto na app (opcional)",
-        itens,
-        use_dejavu,
-        subtitulo="Opções que usou na barra lateral.",
-    )
+def _excel_df_conta_par_modelo_serie(df, col_mod, col_ser):
+    if df is None or df.empty or col_mod not in df.columns or col_ser not in df.columns:
+        return {}
+    d = df[[col_mod, col_ser]].copy()
+    d["_k"] = d[col_mod].astype(str).str.strip() + "|" + d[col_ser].astype(str).str.strip()
+    return d.groupby("_k").size().to_dict()
 
 
-def _pdf_secao_resumo_folha(pdf, titulo, use_dejavu, texto_explicativo=None):
-    """Título de secção + texto explicativo (folhas descritivas 2+)."""
-    pdf.ln(3)
-    pdf.set_draw_color(255, 105, 180)
-    pdf.set_line_width(0.35)
-    yl = pdf.get_y()
-    pdf.line(pdf.l_margin, yl, pdf.l_margin + 28, yl)
-    pdf.set_line_width(0.2)
-    pdf.set_draw_color(255, 192, 216)
-    pdf.line(pdf.l_margin + 30, yl, pdf.w - pdf.r_margin, yl)
-    pdf.ln(2)
-    _pdf_font(pdf, use_dejavu, "B", 9.5)
-    pdf.set_text_color(136, 14, 79)
-    pdf.set_x(pdf.l_margin)
-    pdf.cell(0, 5, _pdf_txt(pdf, titulo, use_dejavu), ln=True)
-    pdf.set_text_color(95, 55, 80)
-    pdf.ln(0.5)
-    if texto_explicativo:
-        _pdf_font(pdf, use_dejavu, "", 7.5)
-        pdf.set_text_color(130, 85, 115)
-        _pdf_multi_texto_largura_total(pdf, 3.6, texto_explicativo, use_dejavu)
-        pdf.set_text_color(60, 40, 55)
-        pdf.ln(0.5)
+def _excel_fmt_milhar_pt(n):
+    try:
+        return f"{int(n):,}".replace(",", ".")
+    except (TypeError, ValueError):
+        return "-"
 
 
-def _pdf_tabela_preview(pdf, preview, use_dejavu, y_max=276, estilo_moderno=False):
-    cols = preview.get("cols") or []
-    rows = preview.get("rows") or []
-    em = preview.get("empty_msg")
-    if em and not cols:
-        _pdf_font(pdf, use_dejavu, "", 8.5)
-        pdf.set_text_color(148, 163, 184)
-        _pdf_multi_texto_largura_total(pdf, 4.5, em, use_dejavu)
-        pdf.set_text_color(30, 41, 59)
-        return
-    if not cols:
-        return
-    max_w = pdf.w - pdf.l_margin - pdf.r_margin
-    n = len(cols)
-    fs = 6.0 if n >= 8 else 7.0
-    row_h = 3.8
-    cw = max_w / n
-
-    def _cabecalho():
-        if estilo_moderno:
-            pdf.set_fill_color(252, 210, 228)
-            pdf.set_draw_color(244, 143, 177)
-            pdf.set_text_color(99, 17, 58)
-        else:
-            pdf.set_fill_color(248, 187, 208)
-            pdf.set_draw_color(236, 160, 188)
-            pdf.set_text_color(55, 55, 60)
-        _pdf_font(pdf, use_dejavu, "B", fs - 0.2)
-        for c in cols:
-            t = str(c)[:16] + ("…" if len(str(c)) > 16 else "")
-            pdf.cell(cw, row_h + 0.7, _pdf_txt(pdf, t, use_dejavu), border=1, align="C", fill=True)
-        pdf.ln()
-
-    _cabecalho()
-    _pdf_font(pdf, use_dejavu, "", fs)
-    for ri, row in enumerate(rows):
-        if pdf.get_y() > y_max:
-            pdf.add_page()
-            _cabecalho()
-            _pdf_font(pdf, use_dejavu, "", fs)
-        if estilo_moderno and ri % 2 == 0:
-            pdf.set_fill_color(255, 248, 252)
-        else:
-            pdf.set_fill_color(255, 255, 255)
-        pdf.set_draw_color(255, 205, 220)
-        for j, cell in enumerate(row):
-            s = str(cell)
-            lim = 14 if cw < 22 else 22
-            if len(s) > lim:
-                s = s[: max(1, lim - 2)] + "…"
-            pdf.set_text_color(75, 40, 60)
-            pdf.cell(cw, row_h, _pdf_txt(pdf, s, use_dejavu), border=1, align="L", fill=True)
-        pdf.ln()
-    pdf.set_text_color(30, 41, 59)
-    if preview.get("truncated"):
-        pdf.ln(1)
-        _pdf_font(pdf, use_dejavu, "", 6.5)
-        pdf.set_text_color(148, 163, 184)
-        tot = preview.get("total", 0)
-        most = len(rows)
-        msg = f"Amostra: {most}/{tot} linhas — Excel na app para tudo."
-        _pdf_multi_texto_largura_total(pdf, 3.5, msg, use_dejavu)
-        pdf.set_text_color(30, 41, 59)
+def _excel_fmt_reais_pt_str(valor):
+    try:
+        v = float(valor)
+    except (TypeError, ValueError):
+        return "R$ 0,00"
+    neg = v < 0
+    v = abs(v)
+    cent = int(round(v * 100 + 1e-9))
+    inte, frac = divmod(cent, 100)
+    s = str(inte)
+    parts = []
+    while len(s) > 3:
+        parts.insert(0, s[-3:])
+        s = s[:-3]
+    if s:
+        parts.insert(0, s)
+    body = ".".join(parts)
+    out = f"R$ {body},{frac:02d}"
+    return f"- {out}" if neg else out
 
 
-def pdf_dashboard_garimpeiro_bytes(kpi, cnpj_fmt="", df_resumo=None):
+def _excel_escrever_painel_fiscal(wb, kpi, usados_nomes):
     """
-    PDF: folha 1 = cabeçalho executivo + quatro cartões KPI, faixa de buracos, cartões por série (emissão própria),
-    listas terceiros / extras; folhas seguintes = indicadores detalhados em tabelas com bordas.
+    Folha estilo dashboard (grelha tipo Excel + gráficos nativos), alinhada ao mock «Painel Fiscal».
+    Dados reais do kpi / dataframes em sessão.
     """
+    sn = _excel_nome_folha_seguro("Painel Fiscal", usados_nomes)
+    ws = wb.add_worksheet(sn)
+    # Parece mais â€œpainelâ€ / menos folha de cálculo (ideia de mock com Excel visual).
     try:
-        from fpdf import FPDF
-        import fpdf as _fpdf_mod
-    except ImportError:
-        return None
-    if not kpi:
-        return None
-
-    font_path = None
-    font_bold_path = None
-    try:
-        _root = Path(_fpdf_mod.__file__).resolve().parent / "font"
-        _p = _root / "DejaVuSans.ttf"
-        if _p.is_file():
-            font_path = str(_p)
-        _pb = _root / "DejaVuSans-Bold.ttf"
-        if _pb.is_file():
-            font_bold_path = str(_pb)
+        ws.hide_gridlines(2)
     except Exception:
-        font_path = None
-        font_bold_path = None
-
-    pdf = FPDF(orientation="P", unit="mm", format="A4")
-    pdf.set_auto_page_break(auto=True, margin=14)
-    pdf.set_margins(12, 12, 12)
-    pdf.add_page()
-
-    use_dejavu = bool(font_path)
-    if use_dejavu:
-        pdf.add_font("DejaVu", "", font_path)
-        if font_bold_path:
-            pdf.add_font("DejaVu", "B", font_bold_path)
+        pass
 
-    linha_cnpj = f"CNPJ {cnpj_fmt}" if cnpj_fmt else None
-    _pdf_cabecalho_executivo_painel(pdf, use_dejavu, linha_cnpj)
-    _pdf_quatro_kpi_cards_executivo(pdf, kpi, use_dejavu)
-    _pdf_faixa_buracos_executivo(pdf, int(kpi.get("n_bur") or 0), use_dejavu)
-    _pdf_serie_cards_emissao_propria(pdf, df_resumo, use_dejavu)
+    pm = dict(kpi.get("pares") or [])
+    sc = kpi.get("sc") or {}
+    n_docs = int(kpi.get("n_docs") or 0)
+    try:
+        n_prop = int(pm.get("XML emissão própria (itens)", 0) or 0)
+    except (TypeError, ValueError):
+        n_prop = 0
+    try:
+        n_terc_xml = int(pm.get("XML terceiros (itens)", 0) or 0)
+    except (TypeError, ValueError):
+        n_terc_xml = 0
+    aut = int(sc.get("AUTORIZADAS", 0) or 0)
+    can = int(sc.get("CANCELADOS", 0) or 0)
+    inu = int(sc.get("INUTILIZADOS", 0) or 0)
+    den = int(sc.get("DENEGADOS", 0) or 0)
+    rej = int(sc.get("REJEITADOS", 0) or 0)
+    valor = float(kpi.get("valor") or 0)
+    n_bur = int(kpi.get("n_bur") or 0)
+    terc_cnt = kpi.get("terc_cnt") or {}
+    if not isinstance(terc_cnt, dict):
+        terc_cnt = {}
 
-    tc = kpi.get("terc_cnt") or {}
-    if tc:
-        pares_tc = sorted(tc.items(), key=lambda x: x[0])
-        _pdf_lista_rosa(
-            pdf,
-            "Terceiros · por tipo de documento",
-            [(str(m), str(int(q))) for m, q in pares_tc],
-            use_dejavu,
-            subtitulo="Contagem de XML recebidos de terceiros (NF-e, NFC-e, CT-e, MDF-e…).",
-        )
+    df_r = st.session_state.get("df_resumo")
+    df_aut = st.session_state.get("df_autorizadas")
+    df_can = st.session_state.get("df_canceladas")
+    df_inu = st.session_state.get("df_inutilizadas")
+    df_bur = st.session_state.get("df_faltantes")
+    if df_bur is not None and not df_bur.empty:
+        if "Serie" in df_bur.columns and "Série" not in df_bur.columns:
+            df_bur = df_bur.rename(columns={"Serie": "Série"})
 
-    tsd = kpi.get("terc_status_dist") or {}
-    if tsd:
-        pares_st = sorted(tsd.items(), key=lambda x: -x[1])
-        _pdf_lista_rosa(
-            pdf,
-            "Terceiros · por status (como na emissão própria)",
-            [(str(k), str(int(v))) for k, v in pares_st],
-            use_dejavu,
-            subtitulo="Situação das linhas de terceiros no relatório geral: normal, cancelada, denegada, rejeitada, etc. (sem buracos nem inutilizadas.)",
-        )
+    c_aut = _excel_df_conta_par_modelo_serie(df_aut, "Modelo", "Série")
+    c_can = _excel_df_conta_par_modelo_serie(df_can, "Modelo", "Série")
+    c_inu = _excel_df_conta_par_modelo_serie(df_inu, "Modelo", "Série")
+    c_bur = _excel_df_conta_par_modelo_serie(df_bur, "Tipo", "Série")
 
-    _pdf_extras_lote_lista_rosa(pdf, kpi, use_dejavu)
-    _pdf_contexto_lista_rosa(pdf, kpi.get("pares", []), use_dejavu)
+    mes_ref = datetime.now().strftime("%m/%Y")
+    ref_txt = "Sim" if pm.get("Referência último nº guardada") == "Sim" else "Não"
+    val_txt = "Sim" if pm.get("Validação autenticidade") == "Sim" else "Não"
+    _df_div = st.session_state.get("df_divergencias")
+    if _df_div is not None and isinstance(_df_div, pd.DataFrame) and not _df_div.empty:
+        n_div = len(_df_div)
+    else:
+        n_div = 0
 
-    pv = kpi.get("pdf_previews") or {}
+    cor_fundo = "#FDFBF7"
+    cor_vinho = "#5D1B36"
+    cor_borda = "#A1869E"
+    cor_texto = "#20232A"
+    marrom = cor_vinho
 
-    pdf.add_page()
-    _pdf_font(pdf, use_dejavu, "B", 11)
-    pdf.set_text_color(136, 14, 79)
-    pdf.set_x(pdf.l_margin)
-    pdf.cell(0, 7, _pdf_txt(pdf, "Indicadores detalhados", use_dejavu), ln=True)
-    _pdf_font(pdf, use_dejavu, "", 7.5)
-    pdf.set_text_color(130, 85, 115)
-    _pdf_multi_texto_largura_total(
-        pdf,
-        3.8,
-        "As secções abaixo repetem a mesma ordem e o mesmo significado que na página do Garimpeiro "
-        "(resumo por série, terceiros e o relatório da leitura em **dois blocos recolhíveis** — emissão própria e, abaixo, terceiros). Cada bloco inclui uma "
-        "nota curta sobre o que a tabela representa.",
-        use_dejavu,
+    fmt_fundo = wb.add_format({"bg_color": cor_fundo})
+    fmt_titulo_dash = wb.add_format(
+        {
+            "bold": True,
+            "font_color": cor_vinho,
+            "bg_color": cor_fundo,
+            "font_size": 14,
+            "valign": "vcenter",
+            "align": "center",
+        }
     )
-    pdf.ln(1)
-    pdf.set_text_color(60, 40, 55)
-
-    def _folha_se_cheio(ymin=238):
-        if pdf.get_y() > ymin:
-            pdf.add_page()
-
-    _ex = {
-        "serie": (
-            "Corresponde ao quadro «Resumo por série»: NF-e, NFC-e e NFS-e com emitente igual ao CNPJ da barra lateral; "
-            "por modelo e série mostra o intervalo de numeração nos ficheiros, a quantidade e o valor contábil somado."
-        ),
-        "terc": (
-            "Corresponde a «Terceiros — total por tipo»: soma de documentos recebidos de terceiros "
-            "(por exemplo NF-e, NFC-e, CT-e, MDF-e) contados neste lote."
-        ),
-        "bur": (
-            "Corresponde à aba «Buracos» (mesma base do resumo por série): faltas de numeração para NF-e, NFC-e e NFS-e "
-            "da sua empresa (emitente = CNPJ da barra lateral). Se guardou «último nº por série» na lateral, só essas séries entram na lista de buracos, a partir desse mês e desse último número."
-        ),
-        "inut": (
-            "Corresponde à aba «Inutilizadas»: notas inutilizadas na Sefaz, incluindo as que declarou "
-            "manualmente sem XML (quando usou essa opção na app)."
-        ),
-        "canc": (
-            "Corresponde à aba «Canceladas»: notas canceladas no conjunto analisado, conforme o interpretado nos XML do lote."
-        ),
-        "aut": (
-            "Corresponde à aba «Autorizadas»: notas com situação normal/autorizada na emissão própria, neste lote."
-        ),
-        "deneg": (
-            "Corresponde à aba «Denegadas» (emissão própria): uso denegado de numeração / situação tratada como denegação nos XML."
-        ),
-        "rej": (
-            "Corresponde à aba «Rejeitadas» (emissão própria): rejeição Sefaz (códigos agregados como rejeitadas na app)."
-        ),
-        "geral": (
-            "Corresponde à aba «Relatório geral» do painel emissão própria, com as colunas principais. A chave de acesso aparece "
-            "abreviada neste PDF; use «Baixar Excel» na app para todas as linhas e colunas completas. O painel **Terceiros** na página tem abas para canceladas, autorizadas, denegadas, rejeitadas e relatório geral (XML recebidos)."
-        ),
-    }
-
-    _pdf_secao_resumo_folha(pdf, "Resumo por série (NF-e / NFC-e / NFS-e)", use_dejavu, _ex["serie"])
-    _pdf_tabela_preview(pdf, pv.get("resumo") or {}, use_dejavu, estilo_moderno=True)
-
-    _pdf_secao_resumo_folha(pdf, "Terceiros — total por tipo", use_dejavu, _ex["terc"])
-    _pdf_tabela_preview(pdf, pv.get("terceiros") or {}, use_dejavu, estilo_moderno=True)
-
-    _folha_se_cheio()
-    _pdf_secao_resumo_folha(pdf, "Buracos", use_dejavu, _ex["bur"])
-    _pdf_tabela_preview(pdf, pv.get("buracos") or {}, use_dejavu, estilo_moderno=True)
-
-    _folha_se_cheio()
-    _pdf_secao_resumo_folha(pdf, "Inutilizadas", use_dejavu, _ex["inut"])
-    _pdf_tabela_preview(pdf, pv.get("inutilizadas") or {}, use_dejavu, estilo_moderno=True)
-
-    _folha_se_cheio()
-    _pdf_secao_resumo_folha(pdf, "Canceladas", use_dejavu, _ex["canc"])
-    _pdf_tabela_preview(pdf, pv.get("canceladas") or {}, use_dejavu, estilo_moderno=True)
-
-    _folha_se_cheio()
-    _pdf_secao_resumo_folha(pdf, "Autorizadas", use_dejavu, _ex["aut"])
-    _pdf_tabela_preview(pdf, pv.get("autorizadas") or {}, use_dejavu, estilo_moderno=True)
+    fmt_titulo_card = wb.add_format(
+        {
+            "bold": True,
+            "font_color": cor_texto,
+            "bg_color": "#FFFFFF",
+            "top": 2,
+            "left": 2,
+            "right": 2,
+            "top_color": cor_borda,
+            "left_color": cor_borda,
+            "right_color": cor_borda,
+            "font_size": 9,
+            "align": "center",
+            "valign": "vcenter",
+            "text_wrap": True,
+        }
+    )
+    fmt_valor_card = wb.add_format(
+        {
+            "bold": True,
+            "font_color": cor_texto,
+            "bg_color": "#FFFFFF",
+            "left": 2,
+            "right": 2,
+            "left_color": cor_borda,
+            "right_color": cor_borda,
+            "font_size": 16,
+            "align": "center",
+            "valign": "vcenter",
+        }
+    )
+    fmt_rodape_card = wb.add_format(
+        {
+            "font_color": cor_texto,
+            "bg_color": "#FFFFFF",
+            "bottom": 2,
+            "left": 2,
+            "right": 2,
+            "bottom_color": cor_borda,
+            "left_color": cor_borda,
+            "right_color": cor_borda,
+            "font_size": 9,
+            "align": "center",
+            "valign": "top",
+            "text_wrap": True,
+        }
+    )
+    fmt_kpi_t = wb.add_format(
+        {
+            "bold": True,
+            "font_size": 10,
+            "font_color": cor_vinho,
+            "bg_color": cor_fundo,
+            "border": 1,
+            "border_color": cor_borda,
+            "text_wrap": True,
+            "valign": "vcenter",
+        }
+    )
+    fmt_kpi_l = wb.add_format(
+        {
+            "font_size": 9,
+            "border": 1,
+            "text_wrap": True,
+            "valign": "vcenter",
+            "bg_color": "#FFFFFF",
+        }
+    )
+    fmt_tab_h = wb.add_format(
+        {
+            "bold": True,
+            "font_color": "#FFFFFF",
+            "bg_color": marrom,
+            "border": 1,
+            "align": "center",
+            "valign": "vcenter",
+            "text_wrap": True,
+        }
+    )
+    fmt_tab_c = wb.add_format({"border": 1, "valign": "vcenter"})
+    fmt_tab_warn = wb.add_format({"border": 1, "font_color": "#C62828", "bold": True})
+    fmt_tab_ok = wb.add_format({"border": 1, "font_color": "#2E7D32"})
+    fmt_foot = wb.add_format({"italic": True, "font_size": 9, "font_color": "#777777"})
 
-    _folha_se_cheio()
-    _pdf_secao_resumo_folha(pdf, "Denegadas", use_dejavu, _ex["deneg"])
-    _pdf_tabela_preview(pdf, pv.get("denegadas") or {}, use_dejavu, estilo_moderno=True)
+    for row in range(0, 42):
+        ws.set_row(row, 20, fmt_fundo)
+    ws.set_row(0, 26)
+    ws.set_row(1, 22)
+    ws.set_column(0, 0, 4, fmt_fundo)
+    ws.set_column(1, 12, 13, fmt_fundo)
 
-    _folha_se_cheio()
-    _pdf_secao_resumo_folha(pdf, "Rejeitadas", use_dejavu, _ex["rej"])
-    _pdf_tabela_preview(pdf, pv.get("rejeitadas") or {}, use_dejavu, estilo_moderno=True)
+    ws.merge_range(0, 1, 0, 12, "GARIMPEIRO | PAINEL FISCAL", fmt_titulo_dash)
+    ws.merge_range(1, 1, 1, 12, "Olá! Bem-vinda à sua boutique de dados.", fmt_titulo_dash)
 
-    _folha_se_cheio(220)
-    _pdf_secao_resumo_folha(pdf, "Relatório geral (colunas principais)", use_dejavu, _ex["geral"])
-    _pdf_tabela_preview(pdf, pv.get("geral") or {}, use_dejavu, estilo_moderno=True)
+    terc_rodape = []
+    try:
+        itens = sorted(terc_cnt.items(), key=lambda x: int(x[1] or 0), reverse=True)
+        for mod, q in itens[:2]:
+            terc_rodape.append(f"{str(mod).strip()}: {_excel_fmt_milhar_pt(int(q or 0))}")
+    except Exception:
+        terc_rodape = []
+    if not terc_rodape:
+        terc_rodape = ["—"]
 
-    pdf.ln(4)
-    _pdf_font(pdf, use_dejavu, "", 6.5)
-    pdf.set_text_color(148, 163, 184)
-    _pdf_multi_texto_largura_total(
-        pdf,
-        3.5,
-        "Garimpeiro · Chaves abreviadas no PDF. Lista completa: Excel na app.",
-        use_dejavu,
+    ws.merge_range(3, 1, 3, 3, "TOTAL DE DOCUMENTOS\nLIDOS (NUM GERAL)", fmt_titulo_card)
+    ws.merge_range(4, 1, 5, 3, _excel_fmt_milhar_pt(n_docs), fmt_valor_card)
+    ws.merge_range(
+        6,
+        1,
+        7,
+        3,
+        f"Próprios: {_excel_fmt_milhar_pt(n_prop)}\nTerceiros: {_excel_fmt_milhar_pt(n_terc_xml)}",
+        fmt_rodape_card,
     )
 
-    _pdf_out = io.BytesIO()
-    pdf.output(_pdf_out)
-    raw = _pdf_out.getvalue()
-    return raw if raw else None
-
+    ws.merge_range(3, 4, 3, 6, "DETALHAMENTO\nEMISSÃO PRÓPRIA", fmt_titulo_card)
+    ws.merge_range(4, 4, 5, 6, f"{_excel_fmt_milhar_pt(aut)} Aut.", fmt_valor_card)
+    ws.merge_range(
+        6,
+        4,
+        7,
+        6,
+        f"Canceladas: {_excel_fmt_milhar_pt(can)}\nInutilizadas: {_excel_fmt_milhar_pt(inu)}\n"
+        f"Denegadas: {_excel_fmt_milhar_pt(den)}\nRejeitadas: {_excel_fmt_milhar_pt(rej)}",
+        fmt_rodape_card,
+    )
 
-def aplicar_compactacao_dfs_sessao():
-    """Compacta DataFrames grandes na sessão (útil no Streamlit Cloud)."""
-    for k in (
-        "df_geral",
-        "df_resumo",
-        "df_faltantes",
-        "df_canceladas",
-        "df_inutilizadas",
-        "df_autorizadas",
-        "df_denegadas",
-        "df_rejeitadas",
-        "df_divergencias",
-    ):
-        v = st.session_state.get(k)
-        if v is not None and isinstance(v, pd.DataFrame) and not v.empty:
-            st.session_state[k] = compactar_dataframe_memoria(v)
-    gc.collect()
+    ws.merge_range(3, 7, 3, 9, "DETALHAMENTO\nDOCUMENTOS TERCEIROS", fmt_titulo_card)
+    ws.merge_range(4, 7, 5, 9, f"{_excel_fmt_milhar_pt(n_terc_xml)} Terc.", fmt_valor_card)
+    ws.merge_range(6, 7, 7, 9, "\n".join(terc_rodape), fmt_rodape_card)
 
+    ws.merge_range(3, 10, 3, 12, "VOLUME\nFINANCEIRO", fmt_titulo_card)
+    ws.merge_range(4, 10, 5, 12, _excel_fmt_reais_pt_str(valor), fmt_valor_card)
+    ws.merge_range(6, 10, 7, 12, "", fmt_rodape_card)
 
-def _ym_tuple(ano, mes):
-    try:
-        return (int(ano), int(mes))
-    except (ValueError, TypeError):
-        return None
+    chart_row = 10
 
+    # Dados ocultos para gráficos (colunas Q-S = 16+)
+    hid_c = 16
+    r0 = 40
+    ws.write(r0, hid_c, "Categoria", fmt_kpi_l)
+    ws.write(r0, hid_c + 1, "Valor", fmt_kpi_l)
+    ws.write(r0 + 1, hid_c, "Autorizadas")
+    ws.write_number(r0 + 1, hid_c + 1, max(0, aut))
+    ws.write(r0 + 2, hid_c, "Canceladas")
+    ws.write_number(r0 + 2, hid_c + 1, max(0, can))
+    ws.write(r0 + 3, hid_c, "Inutilizadas")
+    ws.write_number(r0 + 3, hid_c + 1, max(0, inu))
+    ws.write(r0 + 4, hid_c, "Denegadas")
+    ws.write_number(r0 + 4, hid_c + 1, max(0, den))
+    ws.write(r0 + 5, hid_c, "Rejeitadas")
+    ws.write_number(r0 + 5, hid_c + 1, max(0, rej))
 
-def _ym_gt(ano_a, mes_a, ano_b, mes_b):
-    ta, tb = _ym_tuple(ano_a, mes_a), _ym_tuple(ano_b, mes_b)
-    if not ta or not tb:
-        return False
-    return ta > tb
+    r1 = r0 + 8
+    terc_items = sorted(terc_cnt.items(), key=lambda x: -x[1])[:8]
+    if not terc_items:
+        ws.write(r1, hid_c, "—")
+        ws.write_number(r1, hid_c + 1, 1)
+        n_trows = 1
+    else:
+        n_trows = 0
+        for mod, q in terc_items:
+            ws.write(r1 + n_trows, hid_c, str(mod))
+            ws.write_number(r1 + n_trows, hid_c + 1, int(q))
+            n_trows += 1
 
+    r2 = r1 + max(n_trows, 1) + 2
+    ws.write(r2, hid_c, "Própria (aut.)")
+    ws.write_number(r2, hid_c + 1, max(0, aut))
+    ws.write(r2 + 1, hid_c, "Terceiros (XML)")
+    ws.write_number(r2 + 1, hid_c + 1, max(0, n_terc_xml))
 
-def _ym_eq(ano_a, mes_a, ano_b, mes_b):
-    ta, tb = _ym_tuple(ano_a, mes_a), _ym_tuple(ano_b, mes_b)
-    if not ta or not tb:
-        return False
-    return ta == tb
+    ws.set_column(hid_c, hid_c + 1, None, None, {"hidden": True})
 
+    ch1 = wb.add_chart({"type": "doughnut"})
+    ch1.add_series(
+        {
+            "name": "Emissão própria",
+            "categories": [sn, r0 + 1, hid_c, r0 + 5, hid_c],
+            "values": [sn, r0 + 1, hid_c + 1, r0 + 5, hid_c + 1],
+        }
+    )
+    ch1.set_title({"name": f"STATUS DE EMISSÃO PRÓPRIA ({mes_ref})"})
+    ch1.set_style(10)
+    ws.insert_chart(chart_row, 0, ch1, {"x_scale": 0.95, "y_scale": 0.95})
 
-def _ym_lt(ano_a, mes_a, ano_b, mes_b):
-    ta, tb = _ym_tuple(ano_a, mes_a), _ym_tuple(ano_b, mes_b)
-    if not ta or not tb:
-        return False
-    return ta < tb
-
-
-def buraco_ctx_sessao():
-    """
-    Só activa regras especiais de buracos quando existe **pelo menos um** último nº guardado
-    (Guardar referência com linhas válidas). Nesse caso **só** as séries que estão na grelha da lateral
-    entram na detecção de buracos (a partir do último nº e do mês indicados). Sem referência guardada,
-    buracos usam toda a numeração lida em emissão própria — como antes.
-    """
-    try:
-        rmap = st.session_state.get("seq_ref_ultimos")
-        rm = dict(rmap) if isinstance(rmap, dict) and rmap else {}
-        if not rm:
-            return None, None, {}
-        ar = st.session_state.get("seq_ref_ano")
-        mr = st.session_state.get("seq_ref_mes")
-        if ar is None or mr is None:
-            return None, None, {}
-        return int(ar), int(mr), rm
-    except Exception:
-        return None, None, {}
-
-
-def incluir_numero_no_conjunto_buraco(ano, mes, n, ref_ar, ref_mr, ultimo_u):
-    """
-    Sem referência guardada na lateral (ref_ar/ref_mr ausentes): toda a numeração lida pode gerar buraco.
-    Com referência activa: **só** séries com linha na grelha (último nº definido); as restantes ignoram-se
-    na análise de buracos. Numa série referenciada: mês anterior ao de referência ignorado; no mês de
-    referência só entram notas com nº **maior** que o último informado; meses seguintes seguem a sequência.
-    """
-    if ref_ar is None or ref_mr is None:
-        return True
-    if ultimo_u is None:
-        return False
-    return numero_entra_conjunto_buraco(ano, mes, n, ref_ar, ref_mr, ultimo_u)
-
-
-def ultimo_ref_lookup(ref_map, tipo, serie):
-    """
-    Ãšltimo nº guardado na lateral para modelo|série.
-    Aceita NF-e vs 55 (e restantes códigos Sefaz), série «4» ou «004», para o mapa bater com o que veio
-    da grelha, da planilha ou do XML — senão ultimo_u fica None e as notas **não entram** em nums_buraco.
-    """
-    if not ref_map:
-        return None
-    t_in = str(tipo).strip()
-    s_raw = str(serie).strip()
-
-    tipo_keys: list = []
-    seen_t = set()
-
-    def add_t(x):
-        if x is None:
-            return
-        x = str(x).strip()
-        if not x or x.lower() == "nan":
-            return
-        if x not in seen_t:
-            seen_t.add(x)
-            tipo_keys.append(x)
+    ch2 = wb.add_chart({"type": "doughnut"})
+    last_tr = r1 + n_trows - 1
+    ch2.add_series(
+        {
+            "name": "Terceiros",
+            "categories": [sn, r1, hid_c, last_tr, hid_c],
+            "values": [sn, r1, hid_c + 1, last_tr, hid_c + 1],
+        }
+    )
+    ch2.set_title({"name": f"DISTRIBUIÇÃO TERCEIROS POR MODELO ({mes_ref})"})
+    ch2.set_style(10)
+    ws.insert_chart(chart_row, 5, ch2, {"x_scale": 0.95, "y_scale": 0.95})
 
-    add_t(t_in)
-    t_norm = _normaliza_modelo_filtro(tipo)
-    if t_norm:
-        add_t(t_norm)
-    for _c, _lab in _MODELO_SEFAZ_PARA_RELATORIO.items():
-        if _lab == t_norm or _lab == t_in or _c == t_in:
-            add_t(_c)
-            add_t(_lab)
+    ch3 = wb.add_chart({"type": "area"})
+    ch3.add_series(
+        {
+            "name": "No lote",
+            "categories": [sn, r2, hid_c, r2 + 1, hid_c],
+            "values": [sn, r2, hid_c + 1, r2 + 1, hid_c + 1],
+            "fill": {"color": cor_borda},
+            "line": {"color": cor_vinho},
+        }
+    )
+    ch3.set_title({"name": "RESUMO RÁPIDO (autorizadas própria vs XML terceiros)"})
+    ch3.set_legend({"none": True})
+    ws.insert_chart(chart_row, 10, ch3, {"x_scale": 0.95, "y_scale": 0.95})
 
-    ser_keys: list = []
-    seen_s = set()
+    # Alertas de série (séries com buracos) — à direita, acima dos gráficos
+    alert_row = 3
+    ws.write(alert_row, 14, "ALERTAS DE SÉRIE", fmt_kpi_t)
+    if df_bur is not None and not df_bur.empty and "Tipo" in df_bur.columns and "Série" in df_bur.columns:
+        gb = df_bur.groupby(["Tipo", "Série"]).size().reset_index(name="n")
+        gb = gb.sort_values("n", ascending=False).head(8)
+        ar = alert_row + 1
+        for _, rr in gb.iterrows():
+            ws.write(ar, 14, f"{rr['Tipo']} sér. {rr['Série']}: {int(rr['n'])} buraco(s)", fmt_tab_warn)
+            ar += 1
+            if ar > alert_row + 6:
+                break
+        if ar == alert_row + 1:
+            ws.write(ar, 14, "Nenhum buraco listado.", fmt_tab_ok)
+    else:
+        ws.write(alert_row + 1, 14, "Sem buracos ou dados indisponíveis.", fmt_tab_ok)
 
-    def add_s(x):
-        x = str(x).strip()
-        if x in seen_s:
-            return
-        seen_s.add(x)
-        ser_keys.append(x)
+    ctx_r = alert_row + 10
+    ws.write(ctx_r, 14, f"Último nº guardado: {ref_txt}", fmt_kpi_l)
+    ws.write(ctx_r + 1, 14, f"Autenticidade: {val_txt}", fmt_kpi_l)
+    if n_div:
+        ws.write(ctx_r + 2, 14, f"Divergências XML×Sefaz: {n_div}", fmt_tab_warn)
 
-    add_s(s_raw)
-    if s_raw.isdigit():
-        n = int(s_raw)
-        add_s(str(n))
-        add_s(str(n).zfill(3))
+    # Tabela totalizador (abaixo dos gráficos)
+    t_row = chart_row + 16
+    ws.merge_range(
+        t_row,
+        0,
+        t_row,
+        8,
+        f"TOTALIZADOR DE SÉRIE E FAIXAS ({mes_ref})",
+        fmt_kpi_t,
+    )
+    t_row += 1
+    headers = [
+        "Modelo",
+        "Série",
+        "Faixa (início–fim)",
+        "Qtd lidos",
+        "Autorizadas",
+        "Canceladas",
+        "Inutilizadas",
+        "Buracos",
+        "OK?",
+    ]
+    for c, h in enumerate(headers):
+        ws.write(t_row, c, h, fmt_tab_h)
+    t_row += 1
 
-    for tb in tipo_keys:
-        for sb in ser_keys:
-            k = f"{tb}|{sb}"
-            if k in ref_map:
-                return ref_map[k]
-    return None
+    if df_r is not None and not df_r.empty:
+        doc_col = "Documento" if "Documento" in df_r.columns else None
+        ser_col = "Série" if "Série" in df_r.columns else None
+        if doc_col and ser_col:
+            for _, row in df_r.iterrows():
+                mod = str(row.get(doc_col, "")).strip()
+                ser = str(row.get(ser_col, "")).strip()
+                k = f"{mod}|{ser}"
+                ini = row.get("Início", "")
+                fim = row.get("Fim", "")
+                faixa = f"{ini} – {fim}"
+                qtd = row.get("Quantidade", "")
+                na = int(c_aut.get(k, 0))
+                nc = int(c_can.get(k, 0))
+                ni = int(c_inu.get(k, 0))
+                nb = int(c_bur.get(k, 0))
+                ok = "\u2713" if nb == 0 else "\u25b2"
+                fmt_end = fmt_tab_ok if nb == 0 else fmt_tab_warn
+                ws.write(t_row, 0, mod, fmt_tab_c)
+                ws.write(t_row, 1, ser, fmt_tab_c)
+                ws.write(t_row, 2, faixa, fmt_tab_c)
+                ws.write(t_row, 3, qtd, fmt_tab_c)
+                ws.write_number(t_row, 4, na, fmt_tab_c)
+                ws.write_number(t_row, 5, nc, fmt_tab_c)
+                ws.write_number(t_row, 6, ni, fmt_tab_c)
+                ws.write_number(t_row, 7, nb, fmt_tab_c)
+                ws.write(t_row, 8, ok, fmt_end)
+                t_row += 1
+        else:
+            ws.merge_range(t_row, 0, t_row, 8, "Resumo por série sem colunas esperadas.", fmt_tab_c)
+            t_row += 1
+    else:
+        ws.merge_range(t_row, 0, t_row, 8, "Sem resumo por série neste lote.", fmt_tab_c)
+        t_row += 1
 
+    t_row += 1
+    ws.merge_range(t_row, 0, t_row, 8, "Garimpeiro · Painel gerado a partir do lote atual (mesmos dados que na app).", fmt_foot)
 
-def numero_entra_conjunto_buraco(ano, mes, n, ref_ar, ref_mr, ultimo_u):
-    """
-    Com mês de referência na sessão: ignora competências anteriores; no próprio mês só conta n > último informado;
-    meses posteriores contam. Sem ref_ar/ref_mr na chamada: o chamador trata (incluir_numero… devolve True antes).
-    Se ref está activo mas falta último nº da série, não contar.
-    """
-    if ref_ar is None or ref_mr is None:
-        return True
-    if str(ano) == "0000":
-        return False
-    if _ym_lt(ano, mes, ref_ar, ref_mr):
-        return False
-    if ultimo_u is None:
-        return False
-    if _ym_eq(ano, mes, ref_ar, ref_mr):
-        try:
-            return int(n) > int(ultimo_u)
-        except (TypeError, ValueError):
-            return False
-    return True
+    ws.set_column(0, 0, 12)
+    ws.set_column(1, 1, 10)
+    ws.set_column(2, 2, 24)
+    ws.set_column(3, 8, 11)
+    ws.set_column(14, 15, 20)
 
 
-def falhas_buraco_por_serie(
-    nums_buraco,
-    tipo_doc,
-    serie_str,
-    ultimo_u,
-    gap_max=MAX_SALTO_ENTRE_NOTAS_CONSECUTIVAS,
-    nums_existentes=None,
+def _excel_relatorio_geral_openpyxl_fallback_bytes(
+    df_g,
+    df_bur,
+    df_inu,
+    df_can,
+    df_aut,
+    df_den,
+    df_rej,
+    df_cte,
+    df_terc_rows,
+    *,
+    omit_bur_inu: bool,
+    kpi: dict,
+    incluir_painel_fiscal: bool,
 ):
     """
-    Buracos a partir do último nº informado (se houver): preenche o intervalo até ao primeiro nº relevante nos XMLs
-    e mantém a lógica de trechos (saltos grandes) no restante.
-
-    nums_existentes: todos os nº já lidos no lote para (tipo, série) — notas que não entram em nums_buraco por causa
-    do mês/«último nº» na lateral continuam aqui; sem este filtro apareciam como «buraco» embora o XML existisse.
+    Mesmas folhas de dados que o livro principal, sem layout xlsxwriter (dashboard formatado / painel fiscal).
+    Usado quando xlsxwriter falha por disco ou temp cheio (errno 28).
     """
-    ns = sorted(nums_buraco)
-    if not ns:
-        return []
-    U = None
-    if ultimo_u is not None:
-        try:
-            U = int(ultimo_u)
-        except (TypeError, ValueError):
-            U = None
-    out = []
-    if U is not None:
-        ns_eff = [x for x in ns if x > U]
-        if not ns_eff:
-            return []
-        for b in range(U + 1, ns_eff[0]):
-            out.append({"Tipo": tipo_doc, "Série": serie_str, "Num_Faltante": b})
-        out.extend(enumerar_buracos_por_segmento(ns_eff, tipo_doc, serie_str, gap_max))
-    else:
-        out.extend(enumerar_buracos_por_segmento(ns, tipo_doc, serie_str, gap_max))
-    if nums_existentes:
-        try:
-            ex = {int(x) for x in nums_existentes}
-        except (TypeError, ValueError):
-            ex = set()
-        if ex:
-            out = [r for r in out if int(r["Num_Faltante"]) not in ex]
-    return out
+    buf = io.BytesIO()
+    usados = set()
+    try:
+        with pd.ExcelWriter(buf, engine="openpyxl") as writer:
+            _excel_escrever_folha_df(writer, df_g, "Geral", usados)
+            if not omit_bur_inu:
+                _excel_escrever_folha_df(writer, df_bur, "Buracos", usados)
+                _excel_escrever_folha_df(writer, df_inu, "Inutilizadas", usados)
+            _excel_escrever_folha_df(writer, df_can, "Canceladas", usados)
+            _excel_escrever_folha_df(writer, df_aut, "Autorizadas", usados)
+            _excel_escrever_folha_df(writer, df_den, "Denegadas", usados)
+            _excel_escrever_folha_df(writer, df_rej, "Rejeitadas", usados)
+            _excel_escrever_folha_df(writer, df_cte, "CT-e e CT-e OS", usados)
+            _excel_escrever_folha_df(writer, df_terc_rows, "Terceiros lidas", usados)
+            par = kpi.get("pares") or []
+            if par:
+                df_d = pd.DataFrame(list(par), columns=["Indicador", "Valor"])
+            else:
+                df_d = pd.DataFrame(
+                    {
+                        "Aviso": [
+                            "Export alternativo (sem espaço para xlsxwriter em disco/Temp). "
+                            "Liberte espaço no disco onde está a pasta **temp_windows_ambiente** do Garimpeiro (ou defina **GARIMPEIRO_DATA_ROOT** noutro volume)."
+                        ]
+                    }
+                )
+            _excel_escrever_folha_df(writer, df_d, "Dashboard", usados)
+            df_r = st.session_state.get("df_resumo")
+            if df_r is not None and isinstance(df_r, pd.DataFrame) and not df_r.empty:
+                _excel_escrever_folha_df(writer, df_r, "Resumo por série", usados)
+            tc = kpi.get("terc_cnt") or {}
+            if tc:
+                df_tc = pd.DataFrame(
+                    [
+                        {"Modelo": m, "Quantidade": int(q)}
+                        for m, q in sorted(tc.items(), key=lambda x: str(x[0]))
+                    ]
+                )
+                _excel_escrever_folha_df(writer, df_tc, "Terceiros qtd", usados)
+            if incluir_painel_fiscal:
+                df_pf = pd.DataFrame(
+                    {
+                        "Nota": [
+                            "Painel fiscal: só no export completo (xlsxwriter). "
+                            "Liberte espaço no disco da pasta **temp_windows_ambiente** do Garimpeiro e exporte de novo."
+                        ]
+                    }
+                )
+                _excel_escrever_folha_df(writer, df_pf, "Painel fiscal", usados)
+        return buf.getvalue()
+    except Exception:
+        return None
 
 
-# Grelha «Ãºltimo nÂº por sÃ©rie» (sidebar): nomes canÃ³nicos e aliases (sessÃ£o / encoding).
-SEQ_REF_COL_MODELO = "Modelo"
-SEQ_REF_COL_SERIE = "Série"
-SEQ_REF_COL_ULT = "Último número"
-SEQ_REF_COLS_ORDER = (SEQ_REF_COL_MODELO, SEQ_REF_COL_SERIE, SEQ_REF_COL_ULT)
+def excel_relatorio_geral_com_dashboard_ficheiro(
+    df_geral, caminho=None, *, incluir_painel_fiscal: bool = True, folhas_detalhe: dict | None = None
+):
+    """
+    Excel com várias folhas alinhadas às abas da página da app:
+    Geral, Buracos, Inutilizadas, Canceladas, Autorizadas, Denegadas, Rejeitadas, CT-e e CT-e OS, Terceiros lidas, Dashboard;
+    opcionalmente Painel Fiscal (incluir_painel_fiscal=False para pacote contabilidade).
+    Se ``folhas_detalhe`` for um dict com chaves df_bur, df_inu, df_can, df_aut, df_den, df_rej,
+    usa esses DataFrames em vez dos da sessão (ex.: livro só «terceiros»). Se df_bur e df_inu
+    vierem vazios (caso típico terceiros), as folhas Buracos e Inutilizadas não são criadas.
+    Grava em ``caminho`` (omissão: temporário em `_excel_pasta_temp`, a apagar por quem chama) e devolve o
+    caminho; folhas com mais linhas do que o Excel aceita saem partidas («Geral (1)», «Geral (2)»…).
+    """
+    if df_geral is None or df_geral.empty:
+        return None
+    kpi = coletar_kpis_dashboard()
+    usados_nomes = set()
+
+    if folhas_detalhe is None:
+        df_bur = st.session_state.get("df_faltantes")
+        df_inu = st.session_state.get("df_inutilizadas")
+        df_can = st.session_state.get("df_canceladas")
+        df_aut = st.session_state.get("df_autorizadas")
+        df_den = st.session_state.get("df_denegadas")
+        df_rej = st.session_state.get("df_rejeitadas")
+    else:
+        df_bur = folhas_detalhe.get("df_bur")
+        df_inu = folhas_detalhe.get("df_inu")
+        df_can = folhas_detalhe.get("df_can")
+        df_aut = folhas_detalhe.get("df_aut")
+        df_den = folhas_detalhe.get("df_den")
+        df_rej = folhas_detalhe.get("df_rej")
+        if df_bur is None or not isinstance(df_bur, pd.DataFrame):
+            df_bur = pd.DataFrame()
+        if df_inu is None or not isinstance(df_inu, pd.DataFrame):
+            df_inu = pd.DataFrame()
+        if df_can is None or not isinstance(df_can, pd.DataFrame):
+            df_can = pd.DataFrame()
+        if df_aut is None or not isinstance(df_aut, pd.DataFrame):
+            df_aut = pd.DataFrame()
+        if df_den is None or not isinstance(df_den, pd.DataFrame):
+            df_den = pd.DataFrame()
+        if df_rej is None or not isinstance(df_rej, pd.DataFrame):
+            df_rej = pd.DataFrame()
+
+    df_g = df_geral.reset_index(drop=True)
+    df_g = _df_com_data_emissao_dd_mm_yyyy(df_g)
+    if "Modelo" in df_g.columns:
+        _m = df_g["Modelo"].astype(str).str.strip()
+        df_cte = df_g[_m.isin(("CT-e", "CT-e OS"))].copy()
+    else:
+        df_cte = pd.DataFrame()
+    if "Origem" in df_g.columns:
+        df_terc_rows = df_g[
+            df_g["Origem"].astype(str).str.contains("TERCEIROS", case=False, na=False)
+        ].copy()
+    else:
+        df_terc_rows = pd.DataFrame()
 
+    df_bur = _df_com_data_emissao_dd_mm_yyyy(df_bur)
+    df_inu = _df_com_data_emissao_dd_mm_yyyy(df_inu)
+    df_can = _df_com_data_emissao_dd_mm_yyyy(df_can)
+    df_aut = _df_com_data_emissao_dd_mm_yyyy(df_aut)
+    df_den = _df_com_data_emissao_dd_mm_yyyy(df_den)
+    df_rej = _df_com_data_emissao_dd_mm_yyyy(df_rej)
 
-def _seq_ref_fold(name):
-    """Normaliza cabeçalho para comparação (acentos, espaços)."""
-    t = unicodedata.normalize("NFKC", str(name)).strip()
-    t = "".join(
-        c for c in unicodedata.normalize("NFD", t) if unicodedata.category(c) != "Mn"
+    # Livro só terceiros: buracos/inutilizadas não existem — não criar folhas vazias.
+    _omit_bur_inu = (
+        folhas_detalhe is not None
+        and df_bur.empty
+        and df_inu.empty
     )
-    t = re.sub(r"\s+", "", t)
-    return t.casefold()
 
+    def _escrever(wb):
+        _excel_folha_df_linhas(wb, df_g, "Geral", usados_nomes)
+        if not _omit_bur_inu:
+            _excel_folha_df_linhas(wb, df_bur, "Buracos", usados_nomes)
+            _excel_folha_df_linhas(wb, df_inu, "Inutilizadas", usados_nomes)
+        _excel_folha_df_linhas(wb, df_can, "Canceladas", usados_nomes)
+        _excel_folha_df_linhas(wb, df_aut, "Autorizadas", usados_nomes)
+        _excel_folha_df_linhas(wb, df_den, "Denegadas", usados_nomes)
+        _excel_folha_df_linhas(wb, df_rej, "Rejeitadas", usados_nomes)
+        _excel_folha_df_linhas(wb, df_cte, "CT-e e CT-e OS", usados_nomes)
+        _excel_folha_df_linhas(wb, df_terc_rows, "Terceiros lidas", usados_nomes)
+
+        dash_sn = _excel_nome_folha_seguro("Dashboard", usados_nomes)
+        ws = wb.add_worksheet(dash_sn)
+        title_f = wb.add_format(
+            {"bold": True, "font_size": 16, "font_color": "#AD1457", "valign": "vcenter"}
+        )
+        hdr_f = wb.add_format(
+            {"bold": True, "bg_color": "#F8BBD0", "border": 1, "valign": "vcenter"}
+        )
+        cell_f = wb.add_format({"border": 1, "valign": "vcenter"})
+        sub_f = wb.add_format({"bold": True, "font_size": 11, "bg_color": "#FCE4EC", "border": 1})
+
+        ws.merge_range(0, 0, 0, 3, "Garimpeiro — Dashboard", title_f)
+        ws.set_row(0, 26)
+        row = 2
+        ws.write(row, 0, "Indicador", hdr_f)
+        ws.write(row, 1, "Valor", hdr_f)
+        row += 1
+        for lab, val in kpi["pares"]:
+            ws.write(row, 0, lab, cell_f)
+            ws.write(row, 1, val, cell_f)
+            row += 1
+        row += 1
 
-def _match_seq_ref_column(name):
-    """Mapeia um cabeçalho de coluna para SEQ_REF_COL_* ou None."""
-    raw = str(name).strip()
-    f = _seq_ref_fold(raw)
-    if f == "modelo":
-        return SEQ_REF_COL_MODELO
-    if f in ("serie", "srie"):
-        return SEQ_REF_COL_SERIE
-    if f in ("ultimonumero", "ltimonumero", "ultimon", "ultimon.", "ult.n", "ult.n."):
-        return SEQ_REF_COL_ULT
-    if f.startswith("ltimo") and "num" in f:
-        return SEQ_REF_COL_ULT
-    if "ultimo" in f and "num" in f:
-        return SEQ_REF_COL_ULT
-    return None
+        df_r = st.session_state.get("df_resumo")
+        if df_r is not None and not df_r.empty:
+            last_c = max(5, len(df_r.columns) - 1)
+            ws.merge_range(
+                row,
+                0,
+                row,
+                last_c,
+                "Resumo por série (NF-e / NFC-e / NFS-e, emitente = CNPJ da barra lateral)",
+                sub_f,
+            )
+            row += 1
+            for c, colname in enumerate(df_r.columns):
+                ws.write(row, c, str(colname), hdr_f)
+            row += 1
+            for _, rr in df_r.iterrows():
+                for c, colname in enumerate(df_r.columns):
+                    v = rr[colname]
+                    ws.write(row, c, v, cell_f)
+                row += 1
+            row += 1
 
+        tc = kpi.get("terc_cnt") or {}
+        if tc:
+            ws.merge_range(row, 0, row, 2, "Terceiros — quantidade por modelo", sub_f)
+            row += 1
+            ws.write(row, 0, "Modelo", hdr_f)
+            ws.write(row, 1, "Quantidade", hdr_f)
+            row += 1
+            for mod, q in sorted(tc.items(), key=lambda x: x[0]):
+                ws.write(row, 0, mod, cell_f)
+                ws.write(row, 1, int(q), cell_f)
+                row += 1
 
-def _normalize_seq_ref_df_columns(df):
-    """Renomeia aliases (Serie, Srie, ltimo nº, etc.) para os nomes canónicos."""
-    if df is None or df.empty:
-        return df
-    if all(c in df.columns for c in SEQ_REF_COLS_ORDER):
-        return df
-    rename = {}
-    used = set()
-    for c in df.columns:
-        target = _match_seq_ref_column(c)
-        if target is None or target in used:
-            continue
-        rename[c] = target
-        used.add(target)
-    if rename:
-        df = df.rename(columns=rename)
-    return df
+        ws.set_column(0, 0, 42)
+        ws.set_column(1, 1, 22)
 
+        if incluir_painel_fiscal:
+            _excel_escrever_painel_fiscal(wb, kpi, usados_nomes)
 
-def ultimos_dict_para_dataframe(ultimos_dict):
-    if not ultimos_dict:
-        return pd.DataFrame(columns=list(SEQ_REF_COLS_ORDER))
-    rows = []
-    for kstr, v in ultimos_dict.items():
-        if "|" not in kstr:
-            continue
-        a, b = kstr.split("|", 1)
-        rows.append(
-            {
-                SEQ_REF_COL_MODELO: a.strip(),
-                SEQ_REF_COL_SERIE: b.strip(),
-                SEQ_REF_COL_ULT: int(v),
-            }
+
+    return _excel_gravar_livro(
+        caminho or _excel_caminho_temp(),
+        _escrever,
+        lambda: _excel_relatorio_geral_openpyxl_fallback_bytes(
+            df_g,
+            df_bur,
+            df_inu,
+            df_can,
+            df_aut,
+            df_den,
+            df_rej,
+            df_cte,
+            df_terc_rows,
+            omit_bur_inu=_omit_bur_inu,
+            kpi=kpi,
+            incluir_painel_fiscal=incluir_painel_fiscal,
+        ),
+    )
+
+
+def excel_relatorio_geral_com_dashboard_bytes(
+    df_geral, *, incluir_painel_fiscal: bool = True, folhas_detalhe: dict | None = None
+):
+    """Bytes do livro de `excel_relatorio_geral_com_dashboard_ficheiro` (para `st.download_button`)."""
+    return _excel_ficheiro_para_bytes(
+        excel_relatorio_geral_com_dashboard_ficheiro(
+            df_geral, incluir_painel_fiscal=incluir_painel_fiscal, folhas_detalhe=folhas_detalhe
         )
-    return pd.DataFrame(rows)
+    )
 
 
-def ref_map_from_dataframe(df):
-    """Monta o mapa 'Modelo|Série' -> último a partir da tabela do editor."""
-    out = {}
-    if df is None or df.empty:
-        return out
-    df = _normalize_seq_ref_df_columns(df)
-    for _, row in df.iterrows():
-        modelo = row.get(SEQ_REF_COL_MODELO)
-        if modelo is None or pd.isna(modelo):
-            continue
-        modelo = str(modelo).strip()
-        if not modelo or modelo.lower() == "nan":
-            continue
-        serie = row.get(SEQ_REF_COL_SERIE)
-        if serie is None or pd.isna(serie):
-            serie = ""
-        else:
-            serie = str(serie).strip()
-        if not serie:
-            continue
-        ult = row.get(SEQ_REF_COL_ULT)
-        if ult is None or pd.isna(ult):
-            continue
-        if isinstance(ult, str):
-            d = "".join(filter(str.isdigit, ult.strip()))
-            if not d:
-                continue
-            try:
-                u = int(d)
-            except ValueError:
-                continue
-        else:
-            try:
-                u = int(float(ult))
-            except (TypeError, ValueError):
-                continue
-        if u <= 0:
-            continue
-        out[f"{modelo}|{serie}"] = u
-    return out
+# --- CACHE DE RELATÓRIOS GERADOS (Excel / PDF) ---
+# O mesmo relatório completo sai várias vezes por lote (espelho, resync, «todo o lote lido», Etapa 3, download
+# na página) e o PDF do dashboard era refeito a cada interação. Cada artefacto fica num ficheiro na pasta de
+# dados com nome = SHA-256 do tipo, das opções, das entradas (DataFrames pela assinatura de `_df_sig_hash_memo`,
+# memorizada por DataFrame; o resto em JSON) e da versão deste ficheiro; a sessão não guarda os bytes.
+# Acima de GARIMPEIRO_CACHE_RELATORIOS_MB (omissão 1024) saem os menos usados; 0 desliga (temporários).
+# A pasta é partilhada por todas as sessões e guarda dados fiscais: o que não é usado há mais de
+# GARIMPEIRO_CACHE_RELATORIOS_HORAS (omissão 24) sai sempre. Cada uso (gerar, mostrar o botão, descarregar)
+# renova o mtime; o que foi usado na última hora não sai por tamanho (pode estar num botão de outra sessão).
+# «Gerado em» no Dashboard/PDF fica o da geração — o conteúdo só muda quando mudam as entradas.
+_GARIM_CACHE_RELATORIOS_DIR = os.path.join(_GARIM_ROOT, "cache_relatorios")
+_GARIM_CACHE_RELATORIOS_MAX_BYTES = int(
+    float(os.environ.get("GARIMPEIRO_CACHE_RELATORIOS_MB", "1024") or 1024) * 1024 * 1024
+)
+_GARIM_CACHE_RELATORIOS_PARCIAL_TTL_SEG = 24 * 3600
+_GARIM_CACHE_RELATORIOS_TTL_SEG = float(os.environ.get("GARIMPEIRO_CACHE_RELATORIOS_HORAS", "24") or 24) * 3600
+_GARIM_CACHE_RELATORIOS_EM_USO_SEG = 3600
 
 
-def normalize_seq_ref_editor_df(df):
-    """Prepara a grelha: último nº em texto (evita float/NaN do NumberColumn que some ao recarregar)."""
-    cols = list(SEQ_REF_COLS_ORDER)
-    if df is None or df.empty:
-        return pd.DataFrame(columns=cols)
+@st.cache_resource(show_spinner=False)
+def _artefacto_cache_estado_processo() -> dict:
+    """Estado do cache que dura o processo — o app.py volta a correr a cada rerun e um global renasceria."""
+    return {"podado": False}
 
-    df = _normalize_seq_ref_df_columns(df)
 
-    def _str_model(x):
-        if x is None or pd.isna(x):
-            return None
-        s = str(x).strip()
-        return s if s and s.lower() != "nan" else None
-
-    def _str_ser(x):
-        if x is None or pd.isna(x):
-            return ""
-        return str(x).strip()
+def _artefacto_parte_assinatura(v) -> str:
+    if isinstance(v, pd.DataFrame):
+        sig = _df_sig_hash_frame(v)
+        return "df:" + "\x1f".join(map(str, v.columns)) + ":" + sig
+    try:
+        return json.dumps(v, sort_keys=True, default=str, ensure_ascii=False)
+    except (TypeError, ValueError):
+        return repr(v)
+
+
+def _artefacto_assinatura(tipo: str, partes) -> str:
+    h = hashlib.sha256(f"{tipo}\x00{_garim_app_assinatura()}".encode("utf-8"))
+    for v in partes:
+        h.update(b"\x00")
+        h.update(_artefacto_parte_assinatura(v).encode("utf-8", errors="replace"))
+    return h.hexdigest()
+
+
+def _artefacto_partes_sessao() -> list:
+    """Entradas da sessão que os relatórios completos e o PDF leem além do DataFrame pedido (KPIs, folhas, painel)."""
+    ss = st.session_state
+    rel = ss.get("relatorio")
+    pares = _relatorio_contagem_pares(rel, "Pasta", "Tipo") if rel else {}
+    df_div = ss.get("df_divergencias")
+    return [
+        ss.get("st_counts") or {},
+        sorted((str(k), int(q)) for k, q in pares.items()),
+        _relatorio_len(rel),
+        ss.get("df_resumo"),
+        ss.get("df_faltantes"),
+        ss.get("df_inutilizadas"),
+        ss.get("df_canceladas"),
+        ss.get("df_autorizadas"),
+        ss.get("df_denegadas"),
+        ss.get("df_rejeitadas"),
+        len(df_div) if isinstance(df_div, pd.DataFrame) else 0,
+        bool(ss.get("seq_ref_ultimos")),
+        bool(ss.get("validation_done")),
+    ]
 
-    def _ult_txt(x):
-        if x is None or pd.isna(x):
-            return ""
-        if isinstance(x, bool):
-            return ""
-        if isinstance(x, int):
-            return str(x) if x >= 0 else ""
-        if isinstance(x, float):
-            try:
-                if pd.isna(x):
-                    return ""
-                return str(int(x))
-            except (ValueError, OverflowError):
-                return ""
-        return "".join(filter(str.isdigit, str(x)))
 
-    out = df.reindex(columns=cols).copy()
-    out[SEQ_REF_COL_MODELO] = out[SEQ_REF_COL_MODELO].map(_str_model)
-    out[SEQ_REF_COL_SERIE] = out[SEQ_REF_COL_SERIE].map(_str_ser)
-    out[SEQ_REF_COL_ULT] = out[SEQ_REF_COL_ULT].map(_ult_txt)
-    return out
+def _artefacto_tocar(caminho) -> None:
+    """Marca um artefacto da cache como usado agora (não sai por tamanho na próxima hora)."""
+    try:
+        if os.path.dirname(os.path.abspath(caminho)) == os.path.abspath(_GARIM_CACHE_RELATORIOS_DIR):
+            os.utime(caminho)
+    except (OSError, TypeError, ValueError):
+        pass
 
 
-def collect_seq_ref_from_widgets(struct_v: int, n_rows: int, default_modelo: str = "NF-e") -> pd.DataFrame:
-    """Lê select/text da sidebar (chaves sr_{v}_{i}_*) e devolve DataFrame normalizado."""
-    recs = []
-    for i in range(n_rows):
-        recs.append(
-            {
-                "Modelo": st.session_state.get(f"sr_{struct_v}_{i}_m", default_modelo),
-                "Série": str(st.session_state.get(f"sr_{struct_v}_{i}_s", "") or ""),
-                SEQ_REF_COL_ULT: str(st.session_state.get(f"sr_{struct_v}_{i}_u", "") or ""),
-            }
-        )
-    return normalize_seq_ref_editor_df(pd.DataFrame(recs))
+def _artefacto_cache_podar(excepto: str | None = None) -> None:
+    """
+    Apaga os artefactos sem uso há mais de GARIMPEIRO_CACHE_RELATORIOS_HORAS e, acima de
+    GARIMPEIRO_CACHE_RELATORIOS_MB, os menos usados (mtime) que não foram tocados na última hora.
+    """
+    agora = time.time()
+    ents = []
+    total = 0
+    try:
+        for ent in os.scandir(_GARIM_CACHE_RELATORIOS_DIR):
+            try:
+                if not ent.is_file():
+                    continue
+                est = ent.stat()
+                if ent.name.endswith(".parcial"):
+                    if agora - est.st_mtime > _GARIM_CACHE_RELATORIOS_PARCIAL_TTL_SEG:
+                        os.remove(ent.path)
+                    continue
+                if ent.path != excepto and agora - est.st_mtime > _GARIM_CACHE_RELATORIOS_TTL_SEG:
+                    os.remove(ent.path)
+                    continue
+            except OSError:
+                continue
+            total += est.st_size
+            ents.append((est.st_mtime, est.st_size, ent.path))
+    except OSError:
+        return
+    for mt, tam, caminho in sorted(ents):
+        if total <= _GARIM_CACHE_RELATORIOS_MAX_BYTES:
+            break
+        if caminho == excepto or agora - mt < _GARIM_CACHE_RELATORIOS_EM_USO_SEG:
+            continue
+        try:
+            os.remove(caminho)
+            total -= tam
+        except OSError:
+            pass
 
 
-def item_registro_manual_inutilizado(cnpj_limpo, tipo_man, serie_man, nota_man):
-    serie_str = str(serie_man).strip()
-    return {
-        "Arquivo": "REGISTRO_MANUAL",
-        "Chave": f"MANUAL_INUT_{tipo_man}_{serie_str}_{nota_man}",
-        "Tipo": tipo_man,
-        "Série": serie_str,
-        "Número": int(nota_man),
-        "Status": "INUTILIZADOS",
-        "Pasta": f"EMITIDOS_CLIENTE/SAIDA/{tipo_man}/INUTILIZADOS/0000/01/Serie_{serie_str}",
-        "Valor": 0.0,
-        "Conteúdo": b"",
-        "Ano": "0000",
-        "Mes": "01",
-        "Operacao": "SAIDA",
-        "Data_Emissao": "",
-        "CNPJ_Emit": cnpj_limpo,
-        "Nome_Emit": "INSERÇÃO MANUAL",
-        "Doc_Dest": "",
-        "Nome_Dest": "",
-    }
+def _artefacto_gerar_em(gerar, caminho: str):
+    try:
+        r = gerar(caminho)
+        if not r:
+            return None
+        if not _excel_fonte_e_ficheiro(r):
+            _excel_fonte_gravar(r, caminho)
+        elif os.path.abspath(r) != os.path.abspath(caminho):
+            shutil.copyfile(r, caminho)
+            _excel_fonte_descartar(r)
+        return caminho
+    except BaseException:
+        try:
+            os.remove(caminho)
+        except OSError:
+            pass
+        raise
 
 
-def item_registro_manual_cancelado(cnpj_limpo, tipo_man, serie_man, nota_man):
-    """Cancelamento declarado sem XML de evento (mesmas regras de buraco que inutilizada manual)."""
-    serie_str = str(serie_man).strip()
-    return {
-        "Arquivo": "REGISTRO_MANUAL_CANCELADO",
-        "Chave": f"MANUAL_CANC_{tipo_man}_{serie_str}_{nota_man}",
-        "Tipo": tipo_man,
-        "Série": serie_str,
-        "Número": int(nota_man),
-        "Status": "CANCELADOS",
-        "Pasta": f"EMITIDOS_CLIENTE/SAIDA/{tipo_man}/CANCELADOS/0000/01/Serie_{serie_str}",
-        "Valor": 0.0,
-        "Conteúdo": b"",
-        "Ano": "0000",
-        "Mes": "01",
-        "Operacao": "SAIDA",
-        "Data_Emissao": "",
-        "CNPJ_Emit": cnpj_limpo,
-        "Nome_Emit": "INSERÇÃO MANUAL",
-        "Doc_Dest": "",
-        "Nome_Dest": "",
-    }
+def _artefacto_cache(tipo: str, partes, gerar, sufixo: str = ".xlsx"):
+    """
+    Caminho do artefacto `tipo` para estas `partes`, gerado só na primeira vez por `gerar(caminho)` (grava em
+    `caminho` e devolve-o, ou devolve bytes / None). None se `gerar` não produzir nada. O ficheiro é só de
+    leitura e pode sair da cache mais tarde: quem o usa lê/copia logo. Com a cache desligada (ou a pasta
+    indisponível) é um temporário de `_excel_pasta_temp`, apagado por `_excel_fonte_descartar`.
+    """
+    if _GARIM_CACHE_RELATORIOS_MAX_BYTES > 0:
+        _estado = _artefacto_cache_estado_processo()
+        if not _estado["podado"]:
+            _estado["podado"] = True
+            _artefacto_cache_podar()
+        caminho = os.path.join(_GARIM_CACHE_RELATORIOS_DIR, _artefacto_assinatura(tipo, partes) + sufixo)
+        try:
+            os.utime(caminho)
+            return caminho
+        except OSError:
+            pass
+        try:
+            os.makedirs(_GARIM_CACHE_RELATORIOS_DIR, exist_ok=True)
+        except OSError:
+            caminho = None
+        if caminho:
+            tmp = f"{caminho}.{os.getpid()}_{os.urandom(4).hex()}.parcial"
+            if _artefacto_gerar_em(gerar, tmp) is None:
+                return None
+            try:
+                os.replace(tmp, caminho)
+            except OSError:
+                return tmp if os.path.exists(tmp) else None
+            _artefacto_cache_podar(excepto=caminho)
+            return caminho
+    return _artefacto_gerar_em(gerar, _excel_caminho_temp(tipo)[: -len(".xlsx")] + sufixo)
 
 
-def _inutil_sem_xml_manual(res):
-    """Inutilização declarada manualmente (sem XML de inutilização)."""
-    if str(res.get("Chave") or "").startswith("MANUAL_INUT_"):
-        return True
-    return res.get("Arquivo") == "REGISTRO_MANUAL" and res.get("Status") == "INUTILIZADOS"
+def excel_relatorio_geral_com_dashboard_cache(
+    df_geral, *, incluir_painel_fiscal: bool = True, folhas_detalhe: dict | None = None
+):
+    """`excel_relatorio_geral_com_dashboard_ficheiro` pela cache de relatórios (caminho só de leitura)."""
+    if df_geral is None or df_geral.empty:
+        return None
+    detalhe = []
+    if folhas_detalhe is not None:
+        detalhe = [folhas_detalhe.get(k) for k in ("df_bur", "df_inu", "df_can", "df_aut", "df_den", "df_rej")]
+    return _artefacto_cache(
+        "relatorio_geral",
+        [incluir_painel_fiscal, folhas_detalhe is not None, df_geral, *detalhe, *_artefacto_partes_sessao()],
+        lambda caminho: excel_relatorio_geral_com_dashboard_ficheiro(
+            df_geral, caminho, incluir_painel_fiscal=incluir_painel_fiscal, folhas_detalhe=folhas_detalhe
+        ),
+    )
 
 
-def _cancel_sem_xml_manual(res):
-    """Cancelamento declarado manualmente (sem XML de cancelamento)."""
-    if str(res.get("Chave") or "").startswith("MANUAL_CANC_"):
-        return True
-    return res.get("Arquivo") == "REGISTRO_MANUAL_CANCELADO" and res.get("Status") == "CANCELADOS"
+def pdf_dashboard_garimpeiro_cache(cnpj_fmt=""):
+    """PDF do dashboard da sessão pela cache de relatórios; None se o fpdf2 não estiver instalado."""
+    df_resumo = st.session_state.get("df_resumo")
+    return _artefacto_cache(
+        "dashboard_pdf",
+        [cnpj_fmt, st.session_state.get("df_geral"), *_artefacto_partes_sessao()],
+        lambda _caminho: pdf_dashboard_garimpeiro_bytes(coletar_kpis_dashboard(), cnpj_fmt, df_resumo),
+        sufixo=".pdf",
+    )
 
 
-def _registro_manual_inutil_duplicada(relatorio, tipo, serie_str, nota_int):
-    """Já existe **inutilização** manual (sem XML) para o mesmo modelo/série/nota — não misturar com canceladas."""
-    ser = str(serie_str).strip()
-    for r in relatorio or []:
-        if not _inutil_sem_xml_manual(r):
-            continue
-        if str(r.get("Tipo") or "").strip() != str(tipo).strip():
-            continue
-        if str(r.get("Série") or "").strip() != ser:
-            continue
-        try:
-            if int(r.get("Número") or 0) != int(nota_int):
-                continue
-        except (TypeError, ValueError):
-            continue
-        return True
-    return False
+def _pdf_ascii_seguro(txt):
+    if txt is None:
+        return ""
+    s = str(txt)
+    return (
+        unicodedata.normalize("NFKD", s).encode("ascii", "ignore").decode("ascii") or "-"
+    )
 
 
-def _registro_manual_cancel_duplicada(relatorio, tipo, serie_str, nota_int):
-    """Já existe **cancelamento** manual (sem XML) para o mesmo modelo/série/nota — independente das inutilizadas."""
-    ser = str(serie_str).strip()
-    for r in relatorio or []:
-        if not _cancel_sem_xml_manual(r):
-            continue
-        if str(r.get("Tipo") or "").strip() != str(tipo).strip():
-            continue
-        if str(r.get("Série") or "").strip() != ser:
-            continue
-        try:
-            if int(r.get("Número") or 0) != int(nota_int):
-                continue
-        except (TypeError, ValueError):
-            continue
-        return True
-    return False
+def _pdf_txt(pdf, s, use_dejavu):
+    if use_dejavu:
+        return str(s)
+    return _pdf_ascii_seguro(s)
 
 
-def _relatorio_lista_ja_tem_chave(relatorio_list, chave: str) -> bool:
-    return any(r.get("Chave") == chave for r in (relatorio_list or []))
+def _pdf_font(pdf, use_dejavu, style="", size=10):
+    fam = "DejaVu" if use_dejavu else "Helvetica"
+    try:
+        pdf.set_font(fam, style, size)
+    except Exception:
+        if use_dejavu and style == "B":
+            try:
+                pdf.set_font("DejaVu", "", min(size + 1.4, 16))
+            except Exception:
+                pdf.set_font("Helvetica", "B", size)
+        else:
+            pdf.set_font("Helvetica", "" if not style else "B", size)
 
 
-def _garimpo_aplicar_planilhas_inutil_cancel_no_relatorio(
-    rel_list: list,
-    cnpj_limpo: str,
-    df_faltantes: pd.DataFrame,
-    up_inut,
-    up_canc,
-    texto_inut_colar=None,
-) -> dict:
+def _pdf_multi_texto_largura_total(pdf, altura_linha, texto, use_dejavu):
     """
-    Primeiro garimpo: mesmas planilhas que na lateral — só (modelo, série, nota) que coincidem com buracos
-    em df_faltantes (calculados só com os XML). Vários ficheiros por tipo são lidos e agregados.
-    Opcionalmente aceita **texto colado** da grelha Sefaz / Excel (como no painel após a análise).
+    Texto em bloco na largura útil da página.
+    Evita FPDFException (fpdf2): multi_cell(0, ...) com get_x() à direita — largura útil ~0.
     """
-    out = {"inut": 0, "canc": 0, "msgs": []}
-    bur = conjunto_triplas_buracos(df_faltantes)
+    pdf.set_x(pdf.l_margin)
+    w = max(30.0, pdf.w - pdf.l_margin - pdf.r_margin)
+    pdf.multi_cell(w, altura_linha, _pdf_txt(pdf, texto, use_dejavu))
 
-    def _merge_uploads(up, label):
-        if up is None:
-            return None
-        files = list(up) if isinstance(up, (list, tuple)) else [up]
-        files = [f for f in files if f is not None]
-        if not files:
-            return None
-        dfs_valid = []
-        for f in files:
-            nome = getattr(f, "name", "") or "sem_nome"
-            df, err = dataframe_de_upload_inutil(f)
-            if err:
-                out["msgs"].append(f"**{label}** (`{nome}`): {err}")
-                continue
-            if df is not None and not df.empty:
-                dfs_valid.append(df)
-        if not dfs_valid:
-            return None
-        return pd.concat(dfs_valid, ignore_index=True) if len(dfs_valid) > 1 else dfs_valid[0]
 
-    dfs_inut = []
-    merged_i_up = _merge_uploads(up_inut, "Inutilizadas")
-    if merged_i_up is not None:
-        dfs_inut.append(merged_i_up)
-    if texto_inut_colar and str(texto_inut_colar).strip():
-        _df_pc, _err_pc = dataframe_de_texto_colar_planilha(str(texto_inut_colar).strip())
-        if _err_pc:
-            out["msgs"].append(f"**Inutilizadas** (texto colado): {_err_pc}")
-        elif _df_pc is not None and not _df_pc.empty:
-            dfs_inut.append(_df_pc)
-    merged_i = (
-        pd.concat(dfs_inut, ignore_index=True) if len(dfs_inut) > 1 else (dfs_inut[0] if dfs_inut else None)
-    )
-    if merged_i is not None:
-        tri, err_tr = triplas_inutil_de_dataframe(merged_i)
-        if err_tr:
-            out["msgs"].append(f"**Inutilizadas** (planilhas combinadas): {err_tr}")
-        elif not bur:
-            out["msgs"].append(
-                "**Inutilizadas:** após os XML não há buracos na auditoria — nada importado "
-                "(como na lateral: só linhas que batam com **buraco**)."
-            )
-        else:
-            _seen = set()
-            _ign = 0
-            for _mod, _ser, _nota in tri:
-                _k = (_mod.strip(), str(_ser).strip(), int(_nota))
-                if _k not in bur:
-                    _ign += 1
-                    continue
-                if _k in _seen:
-                    continue
-                _seen.add(_k)
-                _itp = item_registro_manual_inutilizado(cnpj_limpo, _mod, _ser, _nota)
-                if not _relatorio_lista_ja_tem_chave(rel_list, _itp["Chave"]) and not _registro_manual_inutil_duplicada(
-                    rel_list, _mod, _ser, _nota
-                ):
-                    rel_list.append(_itp)
-                    out["inut"] += 1
-            if out["inut"] == 0 and tri:
-                out["msgs"].append(
-                    "**Inutilizadas:** nenhuma linha coincidiu com buraco (ou já existia no relatório)."
-                )
-            if _ign > 0:
-                out["msgs"].append(f"**Inutilizadas:** {_ign} linha(s) ignoradas (não eram buraco).")
+def _pdf_cabecalho_executivo_painel(pdf, use_dejavu, linha_extra=None):
+    """Cabeçalho alinhado ao painel da app: off-white, texto vinho."""
+    y = pdf.get_y()
+    w = pdf.w - pdf.l_margin - pdf.r_margin
+    h = 20.0
+    pdf.set_fill_color(253, 251, 247)
+    pdf.set_draw_color(220, 210, 200)
+    pdf.set_line_width(0.25)
+    pdf.rect(pdf.l_margin, y, w, h, "DF")
+    _pdf_font(pdf, use_dejavu, "B", 12)
+    pdf.set_text_color(93, 27, 54)
+    pdf.set_xy(pdf.l_margin + 4, y + 3.5)
+    pdf.cell(w - 8, 6, _pdf_txt(pdf, "GARIMPEIRO · PAINEL DO LOTE", use_dejavu), ln=False)
+    _pdf_font(pdf, use_dejavu, "", 7.5)
+    pdf.set_text_color(90, 75, 85)
+    sub = "Boutique de dados · mesmo desenho que na página principal do Garimpeiro."
+    if linha_extra:
+        sub = f"{linha_extra} · {sub}"
+    pdf.set_xy(pdf.l_margin + 4, y + 10)
+    pdf.cell(w - 8, 4.5, _pdf_txt(pdf, sub, use_dejavu), ln=False)
+    dt = datetime.now().strftime("%d/%m/%Y · %H:%M")
+    _pdf_font(pdf, use_dejavu, "", 6.5)
+    pdf.set_text_color(130, 115, 125)
+    pdf.set_xy(pdf.l_margin + 4, y + 15)
+    pdf.cell(w - 8, 4, _pdf_txt(pdf, dt, use_dejavu), ln=False)
+    pdf.set_text_color(32, 35, 42)
+    pdf.set_xy(pdf.l_margin, y + h + 3)
 
-    merged_c = _merge_uploads(up_canc, "Canceladas")
-    if merged_c is not None:
-        trc, err_trc = triplas_inutil_de_dataframe(merged_c)
-        if err_trc:
-            out["msgs"].append(f"**Canceladas** (planilhas combinadas): {err_trc}")
-        elif not bur:
-            out["msgs"].append(
-                "**Canceladas:** após os XML não há buracos na auditoria — nada importado da planilha."
-            )
-        else:
-            _seen_c = set()
-            _ign_c = 0
-            for _mod, _ser, _nota in trc:
-                _k = (_mod.strip(), str(_ser).strip(), int(_nota))
-                if _k not in bur:
-                    _ign_c += 1
-                    continue
-                if _k in _seen_c:
-                    continue
-                _seen_c.add(_k)
-                _itpc = item_registro_manual_cancelado(cnpj_limpo, _mod, _ser, _nota)
-                if not _relatorio_lista_ja_tem_chave(rel_list, _itpc["Chave"]) and not _registro_manual_cancel_duplicada(
-                    rel_list, _mod, _ser, _nota
-                ):
-                    rel_list.append(_itpc)
-                    out["canc"] += 1
-            if out["canc"] == 0 and trc:
-                out["msgs"].append(
-                    "**Canceladas:** nenhuma linha coincidiu com buraco (ou já existia no relatório)."
-                )
-            if _ign_c > 0:
-                out["msgs"].append(f"**Canceladas:** {_ign_c} linha(s) ignoradas (não eram buraco).")
 
-    return out
+def _pdf_quatro_kpi_cards_executivo(pdf, kpi, use_dejavu):
+    """Quatro cartões KPI como no Streamlit / Excel (borda #A1869E, fundo branco)."""
+    pm = dict(kpi.get("pares") or [])
+    try:
+        n_prop = int(pm.get("XML emissão própria (itens)", 0) or 0)
+    except (TypeError, ValueError):
+        n_prop = 0
+    try:
+        n_terc_xml = int(pm.get("XML terceiros (itens)", 0) or 0)
+    except (TypeError, ValueError):
+        n_terc_xml = 0
+    n_docs = int(kpi.get("n_docs") or 0)
+    sc = kpi.get("sc") or {}
+    aut = int(sc.get("AUTORIZADAS", 0) or 0)
+    can = int(sc.get("CANCELADOS", 0) or 0)
+    inu = int(sc.get("INUTILIZADOS", 0) or 0)
+    valor = float(kpi.get("valor") or 0.0)
+    terc_cnt = kpi.get("terc_cnt") or {}
+    if not isinstance(terc_cnt, dict):
+        terc_cnt = {}
+    terc_linhas = []
+    try:
+        itens = sorted(terc_cnt.items(), key=lambda x: int(x[1] or 0), reverse=True)
+        for mod, q in itens[:2]:
+            terc_linhas.append(f"{str(mod).strip()}: {_excel_fmt_milhar_pt(int(q or 0))}")
+    except Exception:
+        terc_linhas = []
+    if not terc_linhas:
+        terc_linhas = ["—"]
 
+    specs = [
+        (
+            "TOTAL DE DOCUMENTOS\nLIDOS (N.º GERAL)",
+            _excel_fmt_milhar_pt(n_docs),
+            f"Próprios: {_excel_fmt_milhar_pt(n_prop)}\nTerceiros: {_excel_fmt_milhar_pt(n_terc_xml)}",
+        ),
+        (
+            "DETALHAMENTO\nEMISSÃO PRÓPRIA",
+            f"{_excel_fmt_milhar_pt(aut)} Aut.",
+            f"Canceladas: {_excel_fmt_milhar_pt(can)}\nInutilizadas: {_excel_fmt_milhar_pt(inu)}",
+        ),
+        (
+            "DETALHAMENTO\nDOCUMENTOS TERCEIROS",
+            f"{_excel_fmt_milhar_pt(n_terc_xml)} Terc.",
+            "\n".join(terc_linhas),
+        ),
+        (
+            "VOLUME\nFINANCEIRO",
+            _excel_fmt_reais_pt_str(valor),
+            "Soma do valor contábil no resumo por série",
+        ),
+    ]
 
-def _norm_cab_inutil_col(c):
-    s = unicodedata.normalize("NFD", str(c).strip().lower())
-    s = "".join(ch for ch in s if unicodedata.category(ch) != "Mn")
-    return s.replace(" ", "_")
+    margin = pdf.l_margin
+    full = pdf.w - margin - pdf.r_margin
+    gap = 2.4
+    ncols = 4
+    cw = (full - gap * (ncols - 1)) / ncols
+    y0 = pdf.get_y()
+    card_h = 38.0
+    title_h = 10.5
+    foot_h = 12.0
+    val_h = card_h - title_h - foot_h
+    bor = (161, 134, 158)
+    sep = (210, 195, 205)
 
+    pdf.set_line_width(0.45)
+    for i, (tit, val, foot) in enumerate(specs):
+        x = margin + i * (cw + gap)
+        pdf.set_fill_color(255, 255, 255)
+        pdf.set_draw_color(*bor)
+        pdf.rect(x, y0, cw, card_h, "D")
+        pdf.set_draw_color(*sep)
+        pdf.set_line_width(0.15)
+        pdf.line(x, y0 + title_h, x + cw, y0 + title_h)
+        pdf.line(x, y0 + title_h + val_h, x + cw, y0 + title_h + val_h)
+        pdf.set_line_width(0.45)
 
-def triplas_inutil_de_dataframe(df):
-    """
-    CabeÃ§alhos flexÃ­veis â†’ lista (modelo, série, nota).
-    Modelo: modelo, documento, tipo, doc… | Série: série, serie, ser… | Nota: nota, número, num, num_faltante…
-    """
-    if df is None or df.empty:
-        return None, "A planilha está vazia."
-    df = df.dropna(how="all")
-    if df.empty:
-        return None, "A planilha está vazia."
-    ren = {c: _norm_cab_inutil_col(c) for c in df.columns}
-    d2 = df.rename(columns=ren)
+        _pdf_font(pdf, use_dejavu, "B", 5.8)
+        pdf.set_text_color(32, 35, 42)
+        yl = y0 + 2.2
+        for part in str(tit).split("\n")[:2]:
+            pdf.set_xy(x + 1.5, yl)
+            pdf.cell(cw - 3, 3.4, _pdf_txt(pdf, part.strip(), use_dejavu), align="C", ln=False)
+            yl += 3.5
 
-    def col(*aliases):
-        for a in aliases:
-            if a in d2.columns:
-                return a
-        return None
+        _pdf_font(pdf, use_dejavu, "B", 9.5 if len(val) < 14 else 8.0)
+        pdf.set_text_color(32, 35, 42)
+        pdf.set_xy(x + 1.5, y0 + title_h + 3.5)
+        pdf.cell(cw - 3, val_h - 4, _pdf_txt(pdf, val, use_dejavu), align="C", ln=False)
 
-    cm = col("modelo", "documento", "tipo", "doc", "document", "mod", "cod_mod", "codigo")
-    cs = col("serie", "ser")
-    cn = col("nota", "numero", "num", "num_faltante", "n", "numeracao", "no")
-    if not cm or not cs or not cn:
-        return (
-            None,
-            "Faltam colunas reconhecíveis. Use **Modelo** (código Sefaz **55**, **65**, **57**, **67**, **58** ou NF-e…), "
-            "**Série** e **Nota** (ou Número / Num_Faltante).",
-        )
-    out = []
-    for _, row in d2.iterrows():
-        m = row.get(cm)
-        s = row.get(cs)
-        nraw = row.get(cn)
-        if (m is None or pd.isna(m)) and (s is None or pd.isna(s)) and (nraw is None or pd.isna(nraw)):
-            continue
-        if m is None or pd.isna(m) or s is None or pd.isna(s) or nraw is None or pd.isna(nraw):
-            continue
-        mod = _normaliza_modelo_filtro(m)
-        ser = _normaliza_serie_filtro(s)
-        if not mod or not ser:
-            continue
-        if isinstance(nraw, (int, float)) and not pd.isna(nraw):
-            try:
-                n = int(float(nraw))
-            except (TypeError, ValueError):
-                continue
-        else:
-            d = "".join(filter(str.isdigit, str(nraw)))
-            if not d:
-                continue
-            try:
-                n = int(d)
-            except ValueError:
-                continue
-        if n <= 0:
-            continue
-        out.append((mod, ser, n))
-    if not out:
-        return None, "Nenhuma linha válida (modelo, série e nota preenchidos)."
-    return out, None
+        _pdf_font(pdf, use_dejavu, "", 5.6)
+        pdf.set_text_color(61, 53, 64)
+        yf = y0 + title_h + val_h + 2.0
+        for fl in str(foot).split("\n")[:3]:
+            pdf.set_xy(x + 1.5, yf)
+            pdf.cell(cw - 3, 3.2, _pdf_txt(pdf, fl.strip(), use_dejavu), align="C", ln=False)
+            yf += 3.25
 
+    pdf.set_xy(pdf.l_margin, y0 + card_h + 4)
 
-def dataframe_de_upload_inutil(uploaded_file, max_linhas=50000):
-    """Lê CSV ou Excel enviado pelo utilizador."""
-    if uploaded_file is None:
-        return None, None
-    nome = (getattr(uploaded_file, "name", None) or "").lower()
-    raw = uploaded_file.read()
-    try:
-        uploaded_file.seek(0)
-    except Exception:
-        pass
-    if nome.endswith(".csv"):
-        for enc in ("utf-8-sig", "utf-8", "cp1252", "latin-1"):
-            try:
-                df = pd.read_csv(io.BytesIO(raw), sep=None, engine="python", encoding=enc)
-                break
-            except Exception:
-                df = None
-        if df is None:
-            return None, "Não foi possível ler o CSV (tente UTF-8 ou separador `;` / `,`)."
-    elif nome.endswith((".xlsx", ".xls")):
-        try:
-            df = pd.read_excel(io.BytesIO(raw))
-        except Exception as e:
-            return None, f"Erro ao ler Excel: {e}"
-    else:
-        return None, "Use ficheiro **.csv**, **.xlsx** ou **.xls**."
-    df = _df_inutil_expandir_layout_sefaz_se_aplicavel(df)
-    if len(df) > max_linhas:
-        return None, f"No máximo {max_linhas} linhas por ficheiro."
-    return df, None
-
-
-def _try_expand_sefaz_inutil_num_inicial_final(df: pd.DataFrame):
-    """
-    Exportação típica da Sefaz (inutilizadas): colunas como Ano, Modelo, Série,
-    Número Inicial, Número Final, Protocolo, …
-    Devolve DataFrame com colunas Modelo, Série, Nota (uma linha por nota no intervalo)
-    ou None se o cabeçalho não for este formato.
-    """
-    if df is None or df.empty:
-        return None
-    ren = {c: _norm_cab_inutil_col(c) for c in df.columns}
-    d2 = df.rename(columns=ren)
-    obr = ("modelo", "serie", "numero_inicial", "numero_final")
-    if not all(k in d2.columns for k in obr):
-        return None
-    rows = []
-    lim_faixa = 5000  # alinhado a _MAX_FAIXA_EXPORT_DOM / faixa inutil na UI
-    for _, row in d2.iterrows():
-        if row.isna().all():
-            continue
-        m = row.get("modelo")
-        s = row.get("serie")
-        n0r = row.get("numero_inicial")
-        n1r = row.get("numero_final")
-        try:
-            n0 = int(float(n0r))
-            n1 = int(float(n1r))
-        except (TypeError, ValueError):
-            continue
-        if n0 <= 0 or n1 <= 0:
-            continue
-        if n0 > n1:
-            n0, n1 = n1, n0
-        if (n1 - n0 + 1) > lim_faixa:
-            n1 = n0 + lim_faixa - 1
-        mod = _normaliza_modelo_filtro(m)
-        ser = _normaliza_serie_filtro(s)
-        if not mod or not ser:
-            continue
-        for n in range(n0, n1 + 1):
-            rows.append({"Modelo": mod, "Série": ser, "Nota": int(n)})
-    if not rows:
-        return None
-    return pd.DataFrame(rows)
 
-
-def _df_inutil_expandir_layout_sefaz_se_aplicavel(df: pd.DataFrame):
-    """Após ler Excel/CSV ou texto: se for grelha Sefaz inutil., expande para Modelo/Série/Nota."""
-    if df is None or df.empty:
-        return df
-    exp = _try_expand_sefaz_inutil_num_inicial_final(df)
-    if exp is not None and not exp.empty:
-        return exp
-    return df
+def _pdf_faixa_buracos_executivo(pdf, n_bur, use_dejavu):
+    """Uma linha de contexto: buracos (saiu do antigo quadro 2Ã—2)."""
+    margin = pdf.l_margin
+    full = pdf.w - margin - pdf.r_margin
+    y = pdf.get_y()
+    h = 7.5
+    pdf.set_fill_color(255, 255, 255)
+    pdf.set_draw_color(161, 134, 158)
+    pdf.set_line_width(0.2)
+    pdf.rect(margin, y, full, h, "D")
+    _pdf_font(pdf, use_dejavu, "", 7)
+    pdf.set_text_color(93, 27, 54)
+    pdf.set_xy(margin + 3, y + 2)
+    pdf.cell(
+        full - 6,
+        4,
+        _pdf_txt(
+            pdf,
+            f"Buracos na sequência (emissão própria): {_excel_fmt_milhar_pt(int(n_bur or 0))}",
+            use_dejavu,
+        ),
+        ln=False,
+    )
+    pdf.set_xy(pdf.l_margin, y + h + 3)
 
 
-def dataframe_de_texto_colar_planilha(texto: str, max_linhas: int = 50000):
-    """
-    Interpreta texto colado a partir do site da Sefaz ou do Excel (separador tab, ; ou ,).
-    A primeira linha não vazia deve ser o cabeçalho com colunas reconhecíveis por triplas_inutil_de_dataframe.
-    """
-    t = (texto or "").strip()
-    if not t:
-        return None, None
-    linhas = [ln for ln in t.splitlines() if str(ln).strip()]
-    if not linhas:
-        return None, None
-    buf = "\n".join(linhas)
-    for sep in ("\t", ";", ","):
-        try:
-            df = pd.read_csv(io.StringIO(buf), sep=sep, engine="python")
-            if df is not None and not df.empty and len(df.columns) >= 2:
-                df = _df_inutil_expandir_layout_sefaz_se_aplicavel(df)
-                if len(df) > max_linhas:
-                    return None, f"No máximo {max_linhas} linhas."
-                return df, None
-        except Exception:
-            continue
-    try:
-        df = pd.read_csv(io.StringIO(buf), sep=r"\s+", engine="python")
-        if df is not None and not df.empty and len(df.columns) >= 3:
-            df = _df_inutil_expandir_layout_sefaz_se_aplicavel(df)
-            if len(df) > max_linhas:
-                return None, f"No máximo {max_linhas} linhas."
-            return df, None
-    except Exception:
-        pass
-    return (
-        None,
-        "Não consegui separar colunas. Cole a **tabela com cabeçalho** na 1.ª linha "
-        "(Modelo, Série, Nota **ou** Número Inicial / Número Final como na lista de inutilizadas da Sefaz). "
-        "Selecione a grelha no site, Ctrl+C; as colunas devem estar separadas por tabulação.",
+def _pdf_serie_cards_emissao_propria(pdf, df_resumo, use_dejavu):
+    """CartÃµes no mesmo padrÃ£o dos KPI: cada sÃ©rie da emissÃ£o prÃ³pria com faixa inicialâ€“final."""
+    pdf.ln(1)
+    _pdf_font(pdf, use_dejavu, "B", 9)
+    pdf.set_text_color(93, 27, 54)
+    pdf.set_x(pdf.l_margin)
+    pdf.cell(0, 5, _pdf_txt(pdf, "Emissão própria — séries e faixas de numeração", use_dejavu), ln=True)
+    _pdf_font(pdf, use_dejavu, "", 7)
+    pdf.set_text_color(90, 75, 85)
+    pdf.set_x(pdf.l_margin)
+    pdf.cell(
+        0,
+        4,
+        _pdf_txt(
+            pdf,
+            "Um cartão por modelo e série: menor e maior número de nota encontrados nos ficheiros XML do lote.",
+            use_dejavu,
+        ),
+        ln=True,
     )
+    pdf.ln(1.5)
 
+    if df_resumo is None or not isinstance(df_resumo, pd.DataFrame) or df_resumo.empty:
+        _pdf_font(pdf, use_dejavu, "", 8)
+        pdf.set_text_color(130, 115, 125)
+        pdf.set_x(pdf.l_margin)
+        pdf.cell(0, 5, _pdf_txt(pdf, "Sem linhas no resumo por série.", use_dejavu), ln=True)
+        pdf.ln(2)
+        return
 
-def _computar_df_divergencias_autenticidade(df_geral: pd.DataFrame, triplas_sefaz: list):
-    """
-    Compara (Modelo, Série, Nota) do relatório Sefaz com NF **autorizadas** (Status NORMAIS)
-    de **emissão própria** no relatório geral do XML.
-    """
-    if df_geral is None or df_geral.empty or not triplas_sefaz:
-        return pd.DataFrame()
-    need = {"Modelo", "Série", "Nota", "Status Final", "Origem", "Chave"}
-    if not need.issubset(set(df_geral.columns)):
-        return pd.DataFrame()
-    mp = _mask_emissao_propria_df(df_geral)
-    st_col = df_geral["Status Final"].astype(str).str.upper()
-    m_aut = mp & st_col.eq("NORMAIS")
-    dfp = df_geral.loc[m_aut]
-    xml_set = set()
-    chave_por_tripla = {}
-    for _, row in dfp.iterrows():
-        mod = _normaliza_modelo_filtro(row.get("Modelo"))
-        ser = _normaliza_serie_filtro(row.get("Série"))
-        ni = _nota_int_linha(row)
-        if not mod or ser == "" or ni is None:
-            continue
-        t = (mod, ser, ni)
-        xml_set.add(t)
-        ck = str(row.get("Chave") or "").strip()
-        if ck and t not in chave_por_tripla:
-            chave_por_tripla[t] = ck
-    sefaz_set = set()
-    for mod, ser, n in triplas_sefaz:
-        try:
-            mn = _normaliza_modelo_filtro(mod)
-            sn = _normaliza_serie_filtro(ser)
-            if not mn or sn == "":
-                continue
-            sefaz_set.add((mn, sn, int(n)))
-        except (TypeError, ValueError):
-            continue
-    only_sefaz = sefaz_set - xml_set
-    only_xml = xml_set - sefaz_set
-    out_rows = []
-    for t in sorted(only_sefaz, key=lambda x: (x[0], x[1], x[2])):
-        out_rows.append(
-            {
-                "Tipo divergência": "Na Sefaz / relatório, ausente no XML do lote",
-                "Modelo": t[0],
-                "Série": t[1],
-                "Nota": t[2],
-                "Chave (XML)": "",
-            }
-        )
-    for t in sorted(only_xml, key=lambda x: (x[0], x[1], x[2])):
-        out_rows.append(
-            {
-                "Tipo divergência": "No XML do lote, ausente na Sefaz / relatório",
-                "Modelo": t[0],
-                "Série": t[1],
-                "Nota": t[2],
-                "Chave (XML)": chave_por_tripla.get(t, ""),
-            }
+    doc_col = "Documento" if "Documento" in df_resumo.columns else None
+    ser_col = "Série" if "Série" in df_resumo.columns else ("Serie" if "Serie" in df_resumo.columns else None)
+    if not doc_col or not ser_col:
+        _pdf_font(pdf, use_dejavu, "", 8)
+        pdf.set_text_color(180, 90, 90)
+        pdf.set_x(pdf.l_margin)
+        pdf.cell(
+            0,
+            5,
+            _pdf_txt(pdf, "Resumo sem colunas Documento/Série — cartões não gerados.", use_dejavu),
+            ln=True,
         )
-    return pd.DataFrame(out_rows)
-
+        pdf.ln(2)
+        return
 
-def _tem_upload_autenticidade(up) -> bool:
-    """True se hÃ¡ pelo menos um ficheiro no uploader (lista vazia ou None â†’ False)."""
-    if up is None:
-        return False
-    if isinstance(up, (list, tuple)):
-        return len(up) > 0
-    return True
+    ini_col = "Início" if "Início" in df_resumo.columns else ("Inicio" if "Inicio" in df_resumo.columns else None)
+    fim_col = "Fim" if "Fim" in df_resumo.columns else None
+    qtd_col = "Quantidade" if "Quantidade" in df_resumo.columns else None
+    val_col = "Valor Contábil (R$)" if "Valor Contábil (R$)" in df_resumo.columns else None
 
+    margin = pdf.l_margin
+    full = pdf.w - margin - pdf.r_margin
+    gap_h = 2.4
+    gap_v = 2.8
+    ncols = 2
+    cw = (full - gap_h * (ncols - 1)) / ncols
+    card_h = 35.0
+    title_h = 10.0
+    foot_h = 10.5
+    val_h = card_h - title_h - foot_h
+    bor = (161, 134, 158)
+    sep = (210, 195, 205)
 
-def _aplicar_comparacao_autenticidade(upload_files) -> tuple:
-    """Lê uma ou várias planilhas Sefaz, agrega linhas e cruza com df_geral. Devolve (ok, mensagem)."""
-    st.session_state.pop("df_divergencias", None)
-    st.session_state["validation_done"] = False
-    if upload_files is None:
-        return True, ""
-    files = list(upload_files) if isinstance(upload_files, (list, tuple)) else [upload_files]
-    files = [f for f in files if f is not None]
-    if not files:
-        return True, ""
-    dfs_valid = []
-    for f in files:
-        nome = getattr(f, "name", "") or "sem_nome"
-        df, err = dataframe_de_upload_inutil(f)
-        if err:
-            return False, f"**Autenticidade** (`{nome}`): {err}"
-        if df is not None and not df.empty:
-            dfs_valid.append(df)
-    if not dfs_valid:
-        return False, "**Autenticidade:** nenhum ficheiro tinha linhas de dados (planilhas vazias?)."
-    merged = pd.concat(dfs_valid, ignore_index=True) if len(dfs_valid) > 1 else dfs_valid[0]
-    triplas, err2 = triplas_inutil_de_dataframe(merged)
-    if err2:
-        return False, f"**Autenticidade** ({len(files)} ficheiro(s) combinados): {err2}"
-    df_g = st.session_state.get("df_geral")
-    if df_g is None or (isinstance(df_g, pd.DataFrame) and df_g.empty):
-        return False, "**Autenticidade:** relatório geral vazio — faça o garimpo primeiro."
-    df_div = _computar_df_divergencias_autenticidade(df_g, triplas)
-    if df_div is not None and not df_div.empty:
-        st.session_state["df_divergencias"] = df_div
-    else:
-        st.session_state.pop("df_divergencias", None)
-    st.session_state["validation_done"] = True
-    n_lin = len(triplas)
-    n_div = len(df_div) if df_div is not None else 0
-    n_f = len(files)
-    suf = f"{n_f} ficheiro(s), " if n_f > 1 else ""
-    return (
-        True,
-        f"**Autenticidade:** {suf}**{n_lin}** linha(s) na planilha Sefaz (agregadas); **{n_div}** divergência(s) "
-        f"(autorizadas próprias NORMAIS no XML vs relatório).",
-    )
-
+    recs = [row for _, row in df_resumo.iterrows()]
+    idx = 0
+    while idx < len(recs):
+        y0 = pdf.get_y()
+        if y0 + card_h > 275:
+            pdf.add_page()
+            y0 = pdf.get_y()
+        for col in range(ncols):
+            if idx >= len(recs):
+                break
+            row = recs[idx]
+            x = margin + col * (cw + gap_h)
+            doc = str(row.get(doc_col, "") or "").strip()
+            ser = str(row.get(ser_col, "") or "").strip()
+            if len(doc) > 24:
+                doc = doc[:22] + "…"
+            tit_a = doc if doc else "—"
+            tit_b = f"Série {ser}" if ser else "Série —"
+            ini = row.get(ini_col, "") if ini_col else ""
+            fim = row.get(fim_col, "") if fim_col else ""
+            foot_lines = []
+            if qtd_col is not None and row.get(qtd_col, "") != "" and str(row.get(qtd_col)).strip() != "":
+                try:
+                    qv = int(row[qtd_col])
+                    foot_lines.append(f"Quantidade: {_excel_fmt_milhar_pt(qv)}")
+                except (TypeError, ValueError):
+                    foot_lines.append(f"Quantidade: {row.get(qtd_col)}")
+            if val_col is not None:
+                try:
+                    vv = float(row[val_col])
+                    foot_lines.append(_excel_fmt_reais_pt_str(vv))
+                except (TypeError, ValueError):
+                    pass
 
-def conjunto_triplas_buracos(df_faltantes):
-    """{(Tipo, série_str, Num_Faltante)} a partir da tabela de buracos do garimpeiro."""
-    if df_faltantes is None or df_faltantes.empty:
-        return set()
-    d = df_faltantes.copy()
-    if "Serie" in d.columns and "Série" not in d.columns:
-        d = d.rename(columns={"Serie": "Série"})
-    if not {"Tipo", "Série", "Num_Faltante"}.issubset(d.columns):
-        return set()
-    out = set()
-    for _, row in d.iterrows():
-        try:
-            out.add(
-                (
-                    str(row["Tipo"]).strip(),
-                    str(row["Série"]).strip(),
-                    int(row["Num_Faltante"]),
-                )
-            )
-        except (TypeError, ValueError):
-            continue
-    return out
+            pdf.set_line_width(0.45)
+            pdf.set_fill_color(255, 255, 255)
+            pdf.set_draw_color(*bor)
+            pdf.rect(x, y0, cw, card_h, "D")
+            pdf.set_draw_color(*sep)
+            pdf.set_line_width(0.15)
+            pdf.line(x, y0 + title_h, x + cw, y0 + title_h)
+            pdf.line(x, y0 + title_h + val_h, x + cw, y0 + title_h + val_h)
+            pdf.set_line_width(0.45)
 
+            _pdf_font(pdf, use_dejavu, "B", 6.5)
+            pdf.set_text_color(32, 35, 42)
+            yl = y0 + 2.0
+            pdf.set_xy(x + 1.5, yl)
+            pdf.cell(cw - 3, 3.3, _pdf_txt(pdf, tit_a, use_dejavu), align="C", ln=False)
+            yl += 3.5
+            pdf.set_xy(x + 1.5, yl)
+            pdf.cell(cw - 3, 3.3, _pdf_txt(pdf, tit_b, use_dejavu), align="C", ln=False)
 
-def _dataframe_modelo_planilha_inutil_sem_xml():
-    """Linhas de exemplo com código numérico Sefaz (como na página da Sefaz) — também aceita NF-e, NFC-e…"""
-    return pd.DataFrame(
-        [
-            {"Modelo": 55, "Série": 1, "Nota": 1520},
-            {"Modelo": 55, "Série": 1, "Nota": 1521},
-            {"Modelo": 65, "Série": 2, "Nota": 100},
-            {"Modelo": 57, "Série": 1, "Nota": 500},
-            {"Modelo": 67, "Série": 1, "Nota": 10},
-        ]
-    )
+            inner_w = cw - 3.0
+            gutter = 1.2
+            half_w = (inner_w - gutter) / 2.0
+            x_left = x + 1.5
+            x_right = x + 1.5 + half_w + gutter
+            def _pdf_val_nota_intervalo(v):
+                if v is None or (isinstance(v, float) and pd.isna(v)):
+                    return ""
+                s = str(v).strip()
+                return "" if not s or s.lower() == "nan" else s
 
+            ini_s = _pdf_val_nota_intervalo(ini)
+            fim_s = _pdf_val_nota_intervalo(fim)
+            if not ini_s and not fim_s:
+                ini_s, fim_s = "—", "—"
+            elif not ini_s:
+                ini_s = "—"
+            elif not fim_s:
+                fim_s = "—"
+            fs_ini = 11.0 if len(ini_s) < 11 else (9.0 if len(ini_s) < 16 else 7.5)
+            fs_fim = 11.0 if len(fim_s) < 11 else (9.0 if len(fim_s) < 16 else 7.5)
+            y_mid = y0 + title_h
+            y_num = y_mid + 2.8
+            h_num_cell = 6.8
+            _pdf_font(pdf, use_dejavu, "B", fs_ini)
+            pdf.set_text_color(32, 35, 42)
+            pdf.set_xy(x_left, y_num)
+            pdf.cell(half_w, h_num_cell, _pdf_txt(pdf, ini_s, use_dejavu), align="C", ln=False)
+            _pdf_font(pdf, use_dejavu, "B", fs_fim)
+            pdf.set_xy(x_right, y_num)
+            pdf.cell(half_w, h_num_cell, _pdf_txt(pdf, fim_s, use_dejavu), align="C", ln=False)
+            _pdf_font(pdf, use_dejavu, "", 5.5)
+            pdf.set_text_color(90, 75, 85)
+            y_lbl = y_num + h_num_cell + 0.5
+            pdf.set_xy(x_left, y_lbl)
+            pdf.cell(half_w, 3.2, _pdf_txt(pdf, "Inicial", use_dejavu), align="C", ln=False)
+            pdf.set_xy(x_right, y_lbl)
+            pdf.cell(half_w, 3.2, _pdf_txt(pdf, "Final", use_dejavu), align="C", ln=False)
 
-def _bytes_modelo_planilha_exemplo_xlsx(sheet_name: str):
-    """
-    Gera bytes do .xlsx modelo (exemplo Modelo/Série/Nota).
-    Se xlsxwriter falhar por disco/temp cheio, tenta openpyxl; em falha total devolve None.
-    """
-    df = _dataframe_modelo_planilha_inutil_sem_xml()
-    try:
-        buf = io.BytesIO()
-        with pd.ExcelWriter(buf, engine="xlsxwriter") as writer:
-            df.to_excel(writer, sheet_name=sheet_name, index=False)
-            ws = writer.sheets[sheet_name]
-            ws.set_column(0, 0, 14)
-            ws.set_column(1, 1, 10)
-            ws.set_column(2, 2, 12)
-        return buf.getvalue()
-    except Exception as exc:
-        if not _erro_sem_espaco_disco(exc):
-            raise
-    try:
-        buf2 = io.BytesIO()
-        with pd.ExcelWriter(buf2, engine="openpyxl") as writer:
-            df.to_excel(writer, sheet_name=sheet_name, index=False)
-        return buf2.getvalue()
-    except Exception:
-        return None
+            _pdf_font(pdf, use_dejavu, "", 5.8)
+            pdf.set_text_color(61, 53, 64)
+            yf = y0 + title_h + val_h + 1.8
+            for fl in foot_lines[:2]:
+                if not str(fl).strip():
+                    continue
+                pdf.set_xy(x + 1.5, yf)
+                pdf.cell(cw - 3, 3.0, _pdf_txt(pdf, fl, use_dejavu), align="C", ln=False)
+                yf += 3.05
 
+            idx += 1
+        pdf.set_xy(margin, y0 + card_h + gap_v)
 
-def bytes_modelo_planilha_inutil_sem_xml_xlsx():
-    """Bytes do modelo ou None se não houver espaço para gerar o .xlsx."""
-    return _bytes_modelo_planilha_exemplo_xlsx("Inutil_sem_XML")
+    pdf.ln(1)
 
 
-def bytes_modelo_planilha_cancel_sem_xml_xlsx():
-    """Mesmo layout que inutilizadas (Modelo, Série, Nota) — só canceladas declaradas manualmente."""
-    return _bytes_modelo_planilha_exemplo_xlsx("Cancel_sem_XML")
+def _pdf_lista_rosa(pdf, titulo, pares, use_dejavu, subtitulo=None):
+    """Lista rÃ³tulo â†’ número com linhas em grelha suave (folha 1, como no PDF de referência)."""
+    if not pares:
+        return
+    pdf.ln(2)
+    _pdf_font(pdf, use_dejavu, "B", 9)
+    pdf.set_text_color(173, 20, 87)
+    pdf.set_x(pdf.l_margin)
+    pdf.cell(0, 5, _pdf_txt(pdf, titulo, use_dejavu), ln=True)
+    if subtitulo:
+        _pdf_font(pdf, use_dejavu, "", 7)
+        pdf.set_text_color(130, 85, 115)
+        _pdf_multi_texto_largura_total(pdf, 3.5, subtitulo, use_dejavu)
+    pdf.ln(1)
+    full = pdf.w - pdf.l_margin - pdf.r_margin
+    row_h = 6
+    for lab, val in pares:
+        if pdf.get_y() > 268:
+            pdf.add_page()
+        y = pdf.get_y()
+        pdf.set_fill_color(255, 252, 254)
+        pdf.set_draw_color(255, 192, 216)
+        pdf.rect(pdf.l_margin, y, full, row_h, "D")
+        _pdf_font(pdf, use_dejavu, "", 8)
+        pdf.set_text_color(95, 55, 80)
+        pdf.set_xy(pdf.l_margin + 3, y + 1.3)
+        pdf.cell(full * 0.62, row_h - 2, _pdf_txt(pdf, str(lab), use_dejavu), ln=False)
+        _pdf_font(pdf, use_dejavu, "B", 9.5)
+        pdf.set_text_color(199, 21, 133)
+        pdf.set_xy(pdf.l_margin + full * 0.65, y + 1)
+        pdf.cell(full * 0.32, row_h - 2, _pdf_txt(pdf, str(val), use_dejavu), ln=False, align="R")
+        pdf.set_xy(pdf.l_margin, y + row_h)
+    pdf.ln(0.5)
 
 
-def _dataframe_modelo_lista_especifica_ini_fim_serie():
-    """
-    Modelo para Â«Lista especÃ­ficaÂ» â†’ Excel (nº e série).
-    Uma faixa por linha; cabeçalhos reconhecidos por extrair_faixas_ini_fim_serie_excel.
-    """
-    return pd.DataFrame(
-        [
-            {"Inicial": 1, "Final": 100, "Série": 1},
-            {"Inicial": 500, "Final": 502, "Série": 1},
-        ]
+def _pdf_extras_lote_lista_rosa(pdf, kpi, use_dejavu):
+    """Linhas do relatório geral, valor, XML próprio/terceiro — lista simples."""
+    pm = dict(kpi.get("pares") or [])
+    val = float(kpi.get("valor") or 0)
+    val_txt = _excel_fmt_reais_pt_str(val)
+    itens = []
+    if "Linhas no relatório geral" in pm:
+        itens.append(("Linhas no relatório geral (expandido)", str(pm["Linhas no relatório geral"])))
+    itens.append(("Valor contábil no resumo por série", val_txt))
+    if "XML emissão própria (itens)" in pm:
+        itens.append(("XML emissão própria", str(pm["XML emissão própria (itens)"])))
+    if "XML terceiros (itens)" in pm:
+        itens.append(("XML terceiros", str(pm["XML terceiros (itens)"])))
+    _pdf_lista_rosa(
+        pdf,
+        "Mais números do lote",
+        itens,
+        use_dejavu,
+        subtitulo="Complemento aos totalizadores acima (sem gráficos — só contagem neste garimpo).",
     )
 
 
-def bytes_modelo_lista_especifica_ini_fim_serie_xlsx():
-    """Bytes do .xlsx modelo (Inicial, Final, Série) ou None se não houver espaço para gerar."""
-    df = _dataframe_modelo_lista_especifica_ini_fim_serie()
-    _sn = "Faixas_notas"
-    try:
-        buf = io.BytesIO()
-        with pd.ExcelWriter(buf, engine="xlsxwriter") as writer:
-            df.to_excel(writer, sheet_name=_sn, index=False)
-            ws = writer.sheets[_sn]
-            ws.set_column(0, 0, 12)
-            ws.set_column(1, 1, 12)
-            ws.set_column(2, 2, 14)
-        return buf.getvalue()
-    except Exception as exc:
-        if not _erro_sem_espaco_disco(exc):
-            raise
-    try:
-        buf2 = io.BytesIO()
-        with pd.ExcelWriter(buf2, engine="openpyxl") as writer:
-            df.to_excel(writer, sheet_name=_sn, index=False)
-        return buf2.getvalue()
-    except Exception:
-        return None
-
-
-def _dataframe_modelo_lista_especifica_chaves():
-    """Uma coluna Chave com exemplo (substitua pelas chaves de 44 dígitos)."""
-    return pd.DataFrame(
-        {
-            "Chave": [
-                "35250000000000000000000000000000000000000000",
-                "35250000000000000000000000000000000000000001",
-            ]
-        }
+def _pdf_contexto_lista_rosa(pdf, pares_lista, use_dejavu):
+    """Referência lateral, autenticidade, gerado em — estilo suave."""
+    pm = dict(pares_lista or [])
+    rotulos = [
+        ("Gerado em", "Gerado em"),
+        ("Referência último nº guardada", "Último nº por série (lateral)"),
+        ("Validação autenticidade", "Autenticidade"),
+    ]
+    itens = [(c, pm[k]) for k, c in rotulos if k in pm]
+    if not itens:
+        return
+    _pdf_lista_rosa(
+        pdf,
+        "Contexto na app (opcional)",
+        itens,
+        use_dejavu,
+        subtitulo="Opções que usou na barra lateral.",
     )
 
 
-def bytes_modelo_lista_especifica_chaves_xlsx():
-    """Modelo Excel só com coluna Chave (lista específica)."""
-    df = _dataframe_modelo_lista_especifica_chaves()
-    _sn = "Chaves"
-    try:
-        buf = io.BytesIO()
-        with pd.ExcelWriter(buf, engine="xlsxwriter") as writer:
-            df.to_excel(writer, sheet_name=_sn, index=False)
-            ws = writer.sheets[_sn]
-            ws.set_column(0, 0, 50)
-        return buf.getvalue()
-    except Exception as exc:
-        if not _erro_sem_espaco_disco(exc):
-            raise
-    try:
-        buf2 = io.BytesIO()
-        with pd.ExcelWriter(buf2, engine="openpyxl") as writer:
-            df.to_excel(writer, sheet_name=_sn, index=False)
-        return buf2.getvalue()
-    except Exception:
-        return None
+def _pdf_secao_resumo_folha(pdf, titulo, use_dejavu, texto_explicativo=None):
+    """Título de secção + texto explicativo (folhas descritivas 2+)."""
+    pdf.ln(3)
+    pdf.set_draw_color(255, 105, 180)
+    pdf.set_line_width(0.35)
+    yl = pdf.get_y()
+    pdf.line(pdf.l_margin, yl, pdf.l_margin + 28, yl)
+    pdf.set_line_width(0.2)
+    pdf.set_draw_color(255, 192, 216)
+    pdf.line(pdf.l_margin + 30, yl, pdf.w - pdf.r_margin, yl)
+    pdf.ln(2)
+    _pdf_font(pdf, use_dejavu, "B", 9.5)
+    pdf.set_text_color(136, 14, 79)
+    pdf.set_x(pdf.l_margin)
+    pdf.cell(0, 5, _pdf_txt(pdf, titulo, use_dejavu), ln=True)
+    pdf.set_text_color(95, 55, 80)
+    pdf.ln(0.5)
+    if texto_explicativo:
+        _pdf_font(pdf, use_dejavu, "", 7.5)
+        pdf.set_text_color(130, 85, 115)
+        _pdf_multi_texto_largura_total(pdf, 3.6, texto_explicativo, use_dejavu)
+        pdf.set_text_color(60, 40, 55)
+        pdf.ln(0.5)
 
 
-def _item_inutil_manual_sem_xml(res):
-    """Inutilização «sem XML» inserida pelo utilizador (não vem de ficheiro)."""
-    return (
-        res.get("Status") == "INUTILIZADOS"
-        and _inutil_sem_xml_manual(res)
-        and "EMITIDOS_CLIENTE" in res.get("Pasta", "")
-    )
+def _pdf_tabela_preview(pdf, preview, use_dejavu, y_max=276, estilo_moderno=False):
+    cols = preview.get("cols") or []
+    rows = preview.get("rows") or []
+    em = preview.get("empty_msg")
+    if em and not cols:
+        _pdf_font(pdf, use_dejavu, "", 8.5)
+        pdf.set_text_color(148, 163, 184)
+        _pdf_multi_texto_largura_total(pdf, 4.5, em, use_dejavu)
+        pdf.set_text_color(30, 41, 59)
+        return
+    if not cols:
+        return
+    max_w = pdf.w - pdf.l_margin - pdf.r_margin
+    n = len(cols)
+    fs = 6.0 if n >= 8 else 7.0
+    row_h = 3.8
+    cw = max_w / n
 
+    def _cabecalho():
+        if estilo_moderno:
+            pdf.set_fill_color(252, 210, 228)
+            pdf.set_draw_color(244, 143, 177)
+            pdf.set_text_color(99, 17, 58)
+        else:
+            pdf.set_fill_color(248, 187, 208)
+            pdf.set_draw_color(236, 160, 188)
+            pdf.set_text_color(55, 55, 60)
+        _pdf_font(pdf, use_dejavu, "B", fs - 0.2)
+        for c in cols:
+            t = str(c)[:16] + ("…" if len(str(c)) > 16 else "")
+            pdf.cell(cw, row_h + 0.7, _pdf_txt(pdf, t, use_dejavu), border=1, align="C", fill=True)
+        pdf.ln()
 
-def _lote_recalc_de_relatorio(relatorio_list):
-    """Mesma deduplicação por Chave que reconstruir_dataframes_relatorio_simples."""
-    lote = {}
-    for item in relatorio_list:
-        key = item["Chave"]
-        is_p = "EMITIDOS_CLIENTE" in item["Pasta"]
-        if key in lote:
-            if item["Status"] in [
-                "CANCELADOS",
-                "INUTILIZADOS",
-                "DENEGADOS",
-                "REJEITADOS",
-            ]:
-                lote[key] = (item, is_p)
+    _cabecalho()
+    _pdf_font(pdf, use_dejavu, "", fs)
+    for ri, row in enumerate(rows):
+        if pdf.get_y() > y_max:
+            pdf.add_page()
+            _cabecalho()
+            _pdf_font(pdf, use_dejavu, "", fs)
+        if estilo_moderno and ri % 2 == 0:
+            pdf.set_fill_color(255, 248, 252)
         else:
-            lote[key] = (item, is_p)
-    return lote
+            pdf.set_fill_color(255, 255, 255)
+        pdf.set_draw_color(255, 205, 220)
+        for j, cell in enumerate(row):
+            s = str(cell)
+            lim = 14 if cw < 22 else 22
+            if len(s) > lim:
+                s = s[: max(1, lim - 2)] + "…"
+            pdf.set_text_color(75, 40, 60)
+            pdf.cell(cw, row_h, _pdf_txt(pdf, s, use_dejavu), border=1, align="L", fill=True)
+        pdf.ln()
+    pdf.set_text_color(30, 41, 59)
+    if preview.get("truncated"):
+        pdf.ln(1)
+        _pdf_font(pdf, use_dejavu, "", 6.5)
+        pdf.set_text_color(148, 163, 184)
+        tot = preview.get("total", 0)
+        most = len(rows)
+        msg = f"Amostra: {most}/{tot} linhas — Excel na app para tudo."
+        _pdf_multi_texto_largura_total(pdf, 3.5, msg, use_dejavu)
+        pdf.set_text_color(30, 41, 59)
 
 
-def _conjunto_buracos_sem_inutil_manual(lote_recalc, ref_ar, ref_mr, ref_map):
+def pdf_dashboard_garimpeiro_bytes(kpi, cnpj_fmt="", df_resumo=None):
     """
-    Buracos atuais ignorando inutilizações manuais «sem XML».
-    Tuplas (Tipo, série_str, número) para cruzar com o que o utilizador declara.
-    Mantém todos os modelos em emissão própria (H) para não apagar inutil. manual de NFC-e/CT-e por engano.
+    PDF: folha 1 = cabeçalho executivo + quatro cartões KPI, faixa de buracos, cartões por série (emissão própria),
+    listas terceiros / extras; folhas seguintes = indicadores detalhados em tabelas com bordas.
     """
-    audit_map = {}
-    for k, (res, is_p) in lote_recalc.items():
-        if not is_p:
-            continue
-        if _item_inutil_manual_sem_xml(res):
-            continue
-        sk = (res["Tipo"], res["Série"])
-        if sk not in audit_map:
-            audit_map[sk] = {"nums": set(), "nums_buraco": set(), "valor": 0.0}
-        ult_u = ultimo_ref_lookup(ref_map, res["Tipo"], res["Série"])
-        if res["Status"] == "INUTILIZADOS":
-            r = res.get("Range", (res["Número"], res["Número"]))
-            for n in range(r[0], r[1] + 1):
-                audit_map[sk]["nums"].add(n)
-                if incluir_numero_no_conjunto_buraco(
-                    res["Ano"], res["Mes"], n, ref_ar, ref_mr, ult_u
-                ):
-                    audit_map[sk]["nums_buraco"].add(n)
-        else:
-            if res["Número"] > 0:
-                audit_map[sk]["nums"].add(res["Número"])
-                if incluir_numero_no_conjunto_buraco(
-                    res["Ano"],
-                    res["Mes"],
-                    res["Número"],
-                    ref_ar,
-                    ref_mr,
-                    ult_u,
-                ):
-                    audit_map[sk]["nums_buraco"].add(res["Número"])
-                audit_map[sk]["valor"] += res["Valor"]
+    try:
+        from fpdf import FPDF
+        import fpdf as _fpdf_mod
+    except ImportError:
+        return None
+    if not kpi:
+        return None
 
-    H = set()
-    for (t, s), dados in audit_map.items():
-        ult_lookup = ultimo_ref_lookup(ref_map, t, s) if ref_ar is not None else None
-        for row in falhas_buraco_por_serie(
-            dados["nums_buraco"], t, s, ult_lookup, nums_existentes=dados["nums"]
-        ):
-            H.add((row["Tipo"], str(row["Série"]).strip(), int(row["Num_Faltante"])))
-    return H
+    font_path = None
+    font_bold_path = None
+    try:
+        _root = Path(_fpdf_mod.__file__).resolve().parent / "font"
+        _p = _root / "DejaVuSans.ttf"
+        if _p.is_file():
+            font_path = str(_p)
+        _pb = _root / "DejaVuSans-Bold.ttf"
+        if _pb.is_file():
+            font_bold_path = str(_pb)
+    except Exception:
+        font_path = None
+        font_bold_path = None
 
+    pdf = FPDF(orientation="P", unit="mm", format="A4")
+    pdf.set_auto_page_break(auto=True, margin=14)
+    pdf.set_margins(12, 12, 12)
+    pdf.add_page()
 
-def reconstruir_dataframes_relatorio_simples():
-    """Recalcula tabelas a partir de st.session_state['relatorio'] (status no próprio item)."""
-    rel_list = list(st.session_state["relatorio"])
-    ref_ar, ref_mr, ref_map = buraco_ctx_sessao()
-    _cnpj_cli = "".join(c for c in str(st.session_state.get("cnpj_widget", "")) if c.isdigit())[:14]
+    use_dejavu = bool(font_path)
+    if use_dejavu:
+        pdf.add_font("DejaVu", "", font_path)
+        if font_bold_path:
+            pdf.add_font("DejaVu", "B", font_bold_path)
 
-    lote_full = _lote_recalc_de_relatorio(rel_list)
-    lote_sem_manual = {
-        k: v
-        for k, v in lote_full.items()
-        if not _item_inutil_manual_sem_xml(v[0])
-    }
-    H = _conjunto_buracos_sem_inutil_manual(lote_sem_manual, ref_ar, ref_mr, ref_map)
+    linha_cnpj = f"CNPJ {cnpj_fmt}" if cnpj_fmt else None
+    _pdf_cabecalho_executivo_painel(pdf, use_dejavu, linha_cnpj)
+    _pdf_quatro_kpi_cards_executivo(pdf, kpi, use_dejavu)
+    _pdf_faixa_buracos_executivo(pdf, int(kpi.get("n_bur") or 0), use_dejavu)
+    _pdf_serie_cards_emissao_propria(pdf, df_resumo, use_dejavu)
 
-    drop_ch = set()
-    for k, (res, is_p) in lote_full.items():
-        if not _item_inutil_manual_sem_xml(res):
-            continue
-        r = res.get("Range", (res["Número"], res["Número"]))
-        ra, rb = int(r[0]), int(r[1])
-        ser_s = str(res["Série"]).strip()
-        if not any((res["Tipo"], ser_s, n) in H for n in range(ra, rb + 1)):
-            drop_ch.add(k)
-    if drop_ch:
-        st.session_state["relatorio"] = [x for x in rel_list if x["Chave"] not in drop_ch]
-        rel_list = list(st.session_state["relatorio"])
-        lote_full = _lote_recalc_de_relatorio(rel_list)
+    tc = kpi.get("terc_cnt") or {}
+    if tc:
+        pares_tc = sorted(tc.items(), key=lambda x: x[0])
+        _pdf_lista_rosa(
+            pdf,
+            "Terceiros · por tipo de documento",
+            [(str(m), str(int(q))) for m, q in pares_tc],
+            use_dejavu,
+            subtitulo="Contagem de XML recebidos de terceiros (NF-e, NFC-e, CT-e, MDF-e…).",
+        )
 
-    audit_map = {}
-    canc_list = []
-    inut_list = []
-    aut_list = []
-    deneg_list = []
-    rej_list = []
-    geral_list = []
-
-    for k, (res, is_p) in lote_full.items():
-        if is_p:
-            origem_label = f"EMISSÃO PRÓPRIA ({res['Operacao']})"
-        else:
-            origem_label = f"TERCEIROS ({res['Operacao']})"
-
-        registro_detalhado = {
-            "Origem": origem_label,
-            "Operação": res["Operacao"],
-            "Modelo": res["Tipo"],
-            "Série": res["Série"],
-            "Nota": res["Número"],
-            "Data Emissão": res["Data_Emissao"],
-            "CNPJ Emitente": res["CNPJ_Emit"],
-            "Nome Emitente": res["Nome_Emit"],
-            "Doc Destinatário": res["Doc_Dest"],
-            "Nome Destinatário": res["Nome_Dest"],
-            "UF Destino": res.get("UF_Dest") or "",
-            "Chave": res["Chave"],
-            "Status Final": res["Status"],
-            "Valor": res["Valor"],
-            "Ano": res["Ano"],
-            "Mes": res["Mes"],
-        }
+    tsd = kpi.get("terc_status_dist") or {}
+    if tsd:
+        pares_st = sorted(tsd.items(), key=lambda x: -x[1])
+        _pdf_lista_rosa(
+            pdf,
+            "Terceiros · por status (como na emissão própria)",
+            [(str(k), str(int(v))) for k, v in pares_st],
+            use_dejavu,
+            subtitulo="Situação das linhas de terceiros no relatório geral: normal, cancelada, denegada, rejeitada, etc. (sem buracos nem inutilizadas.)",
+        )
 
-        if res["Status"] == "INUTILIZADOS":
-            r = res.get("Range", (res["Número"], res["Número"]))
-            ra, rb = int(r[0]), int(r[1])
-            _man_inut = _inutil_sem_xml_manual(res)
-            for n in range(ra, rb + 1):
-                if _man_inut:
-                    if (res["Tipo"], str(res["Série"]).strip(), n) not in H:
-                        continue
-                item_inut = registro_detalhado.copy()
-                item_inut.update({"Nota": n, "Status Final": "INUTILIZADA", "Valor": 0.0})
-                geral_list.append(item_inut)
-                if is_p:
-                    inut_list.append({"Modelo": res["Tipo"], "Série": res["Série"], "Nota": n})
-                if _incluir_em_resumo_por_serie(res, is_p, _cnpj_cli):
-                    sk = (res["Tipo"], res["Série"])
-                    if sk not in audit_map:
-                        audit_map[sk] = {"nums": set(), "nums_buraco": set(), "valor": 0.0}
-                    ult_u = ultimo_ref_lookup(ref_map, res["Tipo"], res["Série"])
-                    audit_map[sk]["nums"].add(n)
-                    if _man_inut:
-                        audit_map[sk]["nums_buraco"].add(n)
-                    else:
-                        if incluir_numero_no_conjunto_buraco(
-                            res["Ano"], res["Mes"], n, ref_ar, ref_mr, ult_u
-                        ):
-                            audit_map[sk]["nums_buraco"].add(n)
-        else:
-            geral_list.append(registro_detalhado)
-            if is_p:
-                if res["Status"] == "DENEGADOS":
-                    deneg_list.append(registro_detalhado)
-                elif res["Status"] == "REJEITADOS":
-                    rej_list.append(registro_detalhado)
-                elif res["Número"] > 0:
-                    if res["Status"] == "CANCELADOS":
-                        canc_list.append(registro_detalhado)
-                    elif res["Status"] == "NORMAIS":
-                        aut_list.append(registro_detalhado)
-            if _incluir_em_resumo_por_serie(res, is_p, _cnpj_cli) and res["Número"] > 0:
-                sk = (res["Tipo"], res["Série"])
-                if sk not in audit_map:
-                    audit_map[sk] = {"nums": set(), "nums_buraco": set(), "valor": 0.0}
-                ult_u = ultimo_ref_lookup(ref_map, res["Tipo"], res["Série"])
-                audit_map[sk]["nums"].add(res["Número"])
-                if _cancel_sem_xml_manual(res):
-                    audit_map[sk]["nums_buraco"].add(res["Número"])
-                elif incluir_numero_no_conjunto_buraco(
-                    res["Ano"],
-                    res["Mes"],
-                    res["Número"],
-                    ref_ar,
-                    ref_mr,
-                    ult_u,
-                ):
-                    audit_map[sk]["nums_buraco"].add(res["Número"])
-                audit_map[sk]["valor"] += res["Valor"]
+    _pdf_extras_lote_lista_rosa(pdf, kpi, use_dejavu)
+    _pdf_contexto_lista_rosa(pdf, kpi.get("pares", []), use_dejavu)
 
-    res_final = []
-    fal_final = []
+    pv = kpi.get("pdf_previews") or {}
 
-    for (t, s), dados in audit_map.items():
-        ns = sorted(list(dados["nums"]))
-        if ns:
-            n_min = ns[0]
-            n_max = ns[-1]
-            res_final.append(
-                {
-                    "Documento": t,
-                    "Série": s,
-                    "Início": n_min,
-                    "Fim": n_max,
-                    "Quantidade": len(ns),
-                    "Valor Contábil (R$)": round(dados["valor"], 2),
-                }
-            )
-        ult_lookup = ultimo_ref_lookup(ref_map, t, s) if ref_ar is not None else None
-        fal_final.extend(
-            falhas_buraco_por_serie(
-                dados["nums_buraco"], t, s, ult_lookup, nums_existentes=dados["nums"]
-            )
-        )
+    pdf.add_page()
+    _pdf_font(pdf, use_dejavu, "B", 11)
+    pdf.set_text_color(136, 14, 79)
+    pdf.set_x(pdf.l_margin)
+    pdf.cell(0, 7, _pdf_txt(pdf, "Indicadores detalhados", use_dejavu), ln=True)
+    _pdf_font(pdf, use_dejavu, "", 7.5)
+    pdf.set_text_color(130, 85, 115)
+    _pdf_multi_texto_largura_total(
+        pdf,
+        3.8,
+        "As secções abaixo repetem a mesma ordem e o mesmo significado que na página do Garimpeiro "
+        "(resumo por série, terceiros e o relatório da leitura em **dois blocos recolhíveis** — emissão própria e, abaixo, terceiros). Cada bloco inclui uma "
+        "nota curta sobre o que a tabela representa.",
+        use_dejavu,
+    )
+    pdf.ln(1)
+    pdf.set_text_color(60, 40, 55)
 
-    st.session_state.update(
-        {
-            "df_resumo": pd.DataFrame(res_final),
-            "df_faltantes": pd.DataFrame(fal_final),
-            "df_canceladas": pd.DataFrame(canc_list),
-            "df_inutilizadas": pd.DataFrame(inut_list),
-            "df_autorizadas": pd.DataFrame(aut_list),
-            "df_denegadas": pd.DataFrame(deneg_list),
-            "df_rejeitadas": pd.DataFrame(rej_list),
-            "df_geral": pd.DataFrame(geral_list),
-            "st_counts": {
-                "CANCELADOS": len(canc_list),
-                "INUTILIZADOS": len(inut_list),
-                "AUTORIZADAS": len(aut_list),
-                "DENEGADOS": len(deneg_list),
-                "REJEITADOS": len(rej_list),
-            },
-        }
+    def _folha_se_cheio(ymin=238):
+        if pdf.get_y() > ymin:
+            pdf.add_page()
+
+    _ex = {
+        "serie": (
+            "Corresponde ao quadro «Resumo por série»: NF-e, NFC-e e NFS-e com emitente igual ao CNPJ da barra lateral; "
+            "por modelo e série mostra o intervalo de numeração nos ficheiros, a quantidade e o valor contábil somado."
+        ),
+        "terc": (
+            "Corresponde a «Terceiros — total por tipo»: soma de documentos recebidos de terceiros "
+            "(por exemplo NF-e, NFC-e, CT-e, MDF-e) contados neste lote."
+        ),
+        "bur": (
+            "Corresponde à aba «Buracos» (mesma base do resumo por série): faltas de numeração para NF-e, NFC-e e NFS-e "
+            "da sua empresa (emitente = CNPJ da barra lateral). Se guardou «último nº por série» na lateral, só essas séries entram na lista de buracos, a partir desse mês e desse último número."
+        ),
+        "inut": (
+            "Corresponde à aba «Inutilizadas»: notas inutilizadas na Sefaz, incluindo as que declarou "
+            "manualmente sem XML (quando usou essa opção na app)."
+        ),
+        "canc": (
+            "Corresponde à aba «Canceladas»: notas canceladas no conjunto analisado, conforme o interpretado nos XML do lote."
+        ),
+        "aut": (
+            "Corresponde à aba «Autorizadas»: notas com situação normal/autorizada na emissão própria, neste lote."
+        ),
+        "deneg": (
+            "Corresponde à aba «Denegadas» (emissão própria): uso denegado de numeração / situação tratada como denegação nos XML."
+        ),
+        "rej": (
+            "Corresponde à aba «Rejeitadas» (emissão própria): rejeição Sefaz (códigos agregados como rejeitadas na app)."
+        ),
+        "geral": (
+            "Corresponde à aba «Relatório geral» do painel emissão própria, com as colunas principais. A chave de acesso aparece "
+            "abreviada neste PDF; use «Baixar Excel» na app para todas as linhas e colunas completas. O painel **Terceiros** na página tem abas para canceladas, autorizadas, denegadas, rejeitadas e relatório geral (XML recebidos)."
+        ),
+    }
+
+    _pdf_secao_resumo_folha(pdf, "Resumo por série (NF-e / NFC-e / NFS-e)", use_dejavu, _ex["serie"])
+    _pdf_tabela_preview(pdf, pv.get("resumo") or {}, use_dejavu, estilo_moderno=True)
+
+    _pdf_secao_resumo_folha(pdf, "Terceiros — total por tipo", use_dejavu, _ex["terc"])
+    _pdf_tabela_preview(pdf, pv.get("terceiros") or {}, use_dejavu, estilo_moderno=True)
+
+    _folha_se_cheio()
+    _pdf_secao_resumo_folha(pdf, "Buracos", use_dejavu, _ex["bur"])
+    _pdf_tabela_preview(pdf, pv.get("buracos") or {}, use_dejavu, estilo_moderno=True)
+
+    _folha_se_cheio()
+    _pdf_secao_resumo_folha(pdf, "Inutilizadas", use_dejavu, _ex["inut"])
+    _pdf_tabela_preview(pdf, pv.get("inutilizadas") or {}, use_dejavu, estilo_moderno=True)
+
+    _folha_se_cheio()
+    _pdf_secao_resumo_folha(pdf, "Canceladas", use_dejavu, _ex["canc"])
+    _pdf_tabela_preview(pdf, pv.get("canceladas") or {}, use_dejavu, estilo_moderno=True)
+
+    _folha_se_cheio()
+    _pdf_secao_resumo_folha(pdf, "Autorizadas", use_dejavu, _ex["aut"])
+    _pdf_tabela_preview(pdf, pv.get("autorizadas") or {}, use_dejavu, estilo_moderno=True)
+
+    _folha_se_cheio()
+    _pdf_secao_resumo_folha(pdf, "Denegadas", use_dejavu, _ex["deneg"])
+    _pdf_tabela_preview(pdf, pv.get("denegadas") or {}, use_dejavu, estilo_moderno=True)
+
+    _folha_se_cheio()
+    _pdf_secao_resumo_folha(pdf, "Rejeitadas", use_dejavu, _ex["rej"])
+    _pdf_tabela_preview(pdf, pv.get("rejeitadas") or {}, use_dejavu, estilo_moderno=True)
+
+    _folha_se_cheio(220)
+    _pdf_secao_resumo_folha(pdf, "Relatório geral (colunas principais)", use_dejavu, _ex["geral"])
+    _pdf_tabela_preview(pdf, pv.get("geral") or {}, use_dejavu, estilo_moderno=True)
+
+    pdf.ln(4)
+    _pdf_font(pdf, use_dejavu, "", 6.5)
+    pdf.set_text_color(148, 163, 184)
+    _pdf_multi_texto_largura_total(
+        pdf,
+        3.5,
+        "Garimpeiro · Chaves abreviadas no PDF. Lista completa: Excel na app.",
+        use_dejavu,
     )
+
+    _pdf_out = io.BytesIO()
+    pdf.output(_pdf_out)
+    raw = _pdf_out.getvalue()
+    return raw if raw else None
+
+
+def aplicar_compactacao_dfs_sessao():
+    """Compacta DataFrames grandes na sessão (útil no Streamlit Cloud)."""
+    for k in (
+        "df_geral",
+        "df_resumo",
+        "df_faltantes",
+        "df_canceladas",
+        "df_inutilizadas",
+        "df_autorizadas",
+        "df_denegadas",
+        "df_rejeitadas",
+        "df_divergencias",
+    ):
+        v = st.session_state.get(k)
+        if v is not None and isinstance(v, pd.DataFrame) and not v.empty:
+            st.session_state[k] = compactar_dataframe_memoria(v)
+    gc.collect()
+
+
+def _ym_tuple(ano, mes):
     try:
-        st.session_state.pop("_v2_cascade_cache_v1", None)
-    except Exception:
-        pass
-    aplicar_compactacao_dfs_sessao()
-    _garimpo_registar_aviso_sped_chaves_sem_xml_no_lote(
-        st.session_state.get("df_geral"),
-        str(st.session_state.get(SPED_SESSION_TEXT_KEY) or "").strip(),
-    )
+        return (int(ano), int(mes))
+    except (ValueError, TypeError):
+        return None
 
 
-def _garim_footer_elapsed_txt(t_start):
-    """Texto legível do tempo desde o início (tempo de parede; ver `time.time()` nos chamadores)."""
-    if t_start is None:
-        return "—"
-    e = time.time() - float(t_start)
-    if e < 60:
-        return f"{e:.1f}s" if e < 12 else f"{e:.0f}s"
-    if e < 3600:
-        m = int(e // 60)
-        s = int(e % 60)
-        return f"{m}m {s:02d}s"
-    h = int(e // 3600)
-    m = int((e % 3600) // 60)
-    return f"{h}h {m:02d}m"
+def _ym_gt(ano_a, mes_a, ano_b, mes_b):
+    ta, tb = _ym_tuple(ano_a, mes_a), _ym_tuple(ano_b, mes_b)
+    if not ta or not tb:
+        return False
+    return ta > tb
 
 
-_GARIM_LEITURA_OVERLAY_ID = "garimpeiro-overlay-leitura"
+def _ym_eq(ano_a, mes_a, ano_b, mes_b):
+    ta, tb = _ym_tuple(ano_a, mes_a), _ym_tuple(ano_b, mes_b)
+    if not ta or not tb:
+        return False
+    return ta == tb
 
 
-def _garim_footer_overlay_remove():
-    """Remove o cartão global de progresso (anexado ao `document` da janela principal)."""
-    try:
-        import streamlit.components.v1 as components
-    except ImportError:
-        return
-    _oid = _GARIM_LEITURA_OVERLAY_ID.replace("\\", "\\\\").replace('"', '\\"')
-    components.html(
-        f"""<script>
-(function(){{
-  try {{
-    if (window._garimOvInt) {{ clearInterval(window._garimOvInt); window._garimOvInt = null; }}
-    var d = window.parent && window.parent.document;
-    if (!d) return;
-    var el = d.getElementById("{_oid}");
-    if (el) el.remove();
-  }} catch (e) {{}}
-}})();
-</script>""",
-        height=0,
-        width=0,
-    )
+def _ym_lt(ano_a, mes_a, ano_b, mes_b):
+    ta, tb = _ym_tuple(ano_a, mes_a), _ym_tuple(ano_b, mes_b)
+    if not ta or not tb:
+        return False
+    return ta < tb
 
 
-def _garim_footer_overlay_paint(cur, total, arquivo, fase, t_start):
+def buraco_ctx_sessao():
     """
-    Cartão de estado **no topo da janela**, fixo ao viewport (acompanha o scroll), acima do layout Streamlit.
-    O tempo decorrido atualiza no **browser** (setInterval) a partir de `t_start` = `time.time()` no início da operação.
+    Só activa regras especiais de buracos quando existe **pelo menos um** último nº guardado
+    (Guardar referência com linhas válidas). Nesse caso **só** as séries que estão na grelha da lateral
+    entram na detecção de buracos (a partir do último nº e do mês indicados). Sem referência guardada,
+    buracos usam toda a numeração lida em emissão própria — como antes.
     """
     try:
-        import streamlit.components.v1 as components
-    except ImportError:
-        return
-    tot = max(1, int(total or 1))
-    c = min(int(cur or 0), tot)
-    pct = min(100.0, (c / float(tot)) * 100.0)
-    _an = str(arquivo or "—").replace("\\", "/")
-    _base = os.path.basename(_an) or _an
-    arq = html_escape.escape(_base)[:72]
-    fase_e = html_escape.escape(str(fase or ""))[:56]
-    elapsed0 = html_escape.escape(_garim_footer_elapsed_txt(t_start))
-    tit = html_escape.escape(f"{fase or ''} · {_base}")[:220]
-    try:
-        start_ms = int(float(t_start) * 1000) if t_start is not None else 0
-    except (TypeError, ValueError):
-        start_ms = 0
-    inner = (
-        '<div style="position:relative;z-index:1;margin:max(10px, env(safe-area-inset-top)) auto 0;'
-        "max-width:min(800px, calc(100vw - 22px));padding:0 4px;\">"
-        "<div style=\"width:100%;background:linear-gradient(180deg,#fffdfb 0%,#fff5f9 100%);"
-        "backdrop-filter:blur(14px);-webkit-backdrop-filter:blur(14px);border-radius:14px;"
-        "border:1.5px solid rgba(255,105,180,0.58);box-shadow:0 10px 32px rgba(93,27,54,0.22),0 0 0 1px rgba(255,255,255,0.88) inset;"
-        "padding:0.48rem 0.8rem 0.52rem;font-size:0.8rem;font-family:'Plus Jakarta Sans',system-ui,sans-serif;color:#3a2830;\">"
-        "<style>@keyframes garimOvDot{0%,100%{opacity:1;box-shadow:0 0 0 0 rgba(255,105,180,0.45)}50%{opacity:0.68;box-shadow:0 0 0 6px rgba(255,105,180,0)}}</style>"
-        "<div style=\"display:flex;align-items:center;flex-wrap:wrap;gap:0.4rem 0.5rem;margin-bottom:0.22rem;line-height:1.3;\">"
-        "<span style=\"display:inline-block;width:8px;height:8px;border-radius:50%;background:#ff69b4;flex-shrink:0;"
-        "animation:garimOvDot 1.45s ease-in-out infinite;\"></span>"
-        "<strong style=\"color:#5D1B36;font-size:0.86rem;\">Garimpo</strong>"
-        "</div>"
-        "<div style=\"display:flex;align-items:center;gap:0.48rem;flex-wrap:wrap;\">"
-        "<span style=\"font-variant-numeric:tabular-nums;white-space:nowrap;\">⏱ "
-        f'<span id="garimpeiro-overlay-elapsed">{elapsed0}</span></span>'
-        f"<span style=\"opacity:0.9;white-space:nowrap;\"><b>{c}</b>/<b>{tot}</b></span>"
-        f'<span style="flex:1;min-width:96px;opacity:0.88;overflow:hidden;text-overflow:ellipsis;white-space:nowrap;'
-        f'font-size:0.74rem;" title="{tit}">{fase_e} · {arq}</span>'
-        "</div>"
-        f"<div style=\"margin-top:0.38rem;height:7px;background:rgba(255,105,180,0.14);border-radius:6px;overflow:hidden;\">"
-        f"<div style=\"width:{pct:.1f}%;height:100%;background:linear-gradient(90deg,#ff9ec7,#ff69b4);border-radius:6px;\">"
-        "</div></div></div></div>"
-    )
-    b64 = base64.b64encode(inner.encode("utf-8")).decode("ascii")
-    _oid_js = _GARIM_LEITURA_OVERLAY_ID.replace("\\", "\\\\").replace('"', '\\"')
-    _sms = str(start_ms)
-    components.html(
-        f"""<script>
-(function(){{
-  try {{
-    var p = window.parent;
-    if (!p || !p.document) return;
-    var d = p.document;
-    var id = "{_oid_js}";
-    var el = d.getElementById(id);
-    if (!el) {{
-      el = d.createElement("div");
-      el.id = id;
-      el.setAttribute("role", "status");
-      el.setAttribute("aria-live", "polite");
-      el.style.cssText = "position:fixed;top:0;left:0;right:0;z-index:2147483646;pointer-events:none;";
-      d.body.appendChild(el);
-    }}
-    var raw = atob("{b64}");
-    var bin = new Uint8Array(raw.length);
-    for (var i = 0; i < raw.length; i++) bin[i] = raw.charCodeAt(i);
-    el.innerHTML = new TextDecoder("utf-8").decode(bin);
-    var startMs = parseInt("{_sms}", 10);
-    function _garimFmtSec(sec) {{
-      if (!(sec >= 0) || sec === null || isNaN(sec)) return "—";
-      if (sec < 60) return (sec < 12 ? sec.toFixed(1) : Math.round(sec)) + "s";
-      if (sec < 3600) {{
-        var m = Math.floor(sec / 60), s = Math.floor(sec % 60);
-        return m + "m " + (s < 10 ? "0" : "") + s + "s";
-      }}
-      var h = Math.floor(sec / 3600), m2 = Math.floor((sec % 3600) / 60);
-      return h + "h " + (m2 < 10 ? "0" : "") + m2 + "m";
-    }}
-    if (window._garimOvInt) {{ clearInterval(window._garimOvInt); window._garimOvInt = null; }}
-    if (startMs > 0) {{
-      window._garimOvInt = setInterval(function() {{
-        var node = d.getElementById("garimpeiro-overlay-elapsed");
-        if (!node) return;
-        node.textContent = _garimFmtSec((Date.now() - startMs) / 1000);
-      }}, 200);
-      var n0 = d.getElementById("garimpeiro-overlay-elapsed");
-      if (n0) n0.textContent = _garimFmtSec((Date.now() - startMs) / 1000);
-    }}
-  }} catch (e) {{}}
-}})();
-</script>""",
-        height=0,
-        width=0,
-    )
+        rmap = st.session_state.get("seq_ref_ultimos")
+        rm = dict(rmap) if isinstance(rmap, dict) and rmap else {}
+        if not rm:
+            return None, None, {}
+        ar = st.session_state.get("seq_ref_ano")
+        mr = st.session_state.get("seq_ref_mes")
+        if ar is None or mr is None:
+            return None, None, {}
+        return int(ar), int(mr), rm
+    except Exception:
+        return None, None, {}
 
 
-def _garim_footer_render(placeholder, cur, total, arquivo, fase, t_start):
+def incluir_numero_no_conjunto_buraco(ano, mes, n, ref_ar, ref_mr, ultimo_u):
     """
-    Atualiza o cartão global de progresso (topo do ecrã, fixo ao viewport).
-    `placeholder`, se não for None, é esvaziado — o conteúdo real vai para o `document` da janela principal.
+    Sem referência guardada na lateral (ref_ar/ref_mr ausentes): toda a numeração lida pode gerar buraco.
+    Com referência activa: **só** séries com linha na grelha (último nº definido); as restantes ignoram-se
+    na análise de buracos. Numa série referenciada: mês anterior ao de referência ignorado; no mês de
+    referência só entram notas com nº **maior** que o último informado; meses seguintes seguem a sequência.
     """
-    try:
-        _garim_footer_overlay_paint(cur, total, arquivo, fase, t_start)
-    except Exception:
-        pass
-    if placeholder is not None:
-        try:
-            placeholder.empty()
-        except Exception:
-            pass
+    if ref_ar is None or ref_mr is None:
+        return True
+    if ultimo_u is None:
+        return False
+    return numero_entra_conjunto_buraco(ano, mes, n, ref_ar, ref_mr, ultimo_u)
 
 
-def reprocessar_garimpeiro_a_partir_do_disco(cnpj_limpo: str, footer_ph=None, t_start=None):
+def ultimo_ref_lookup(ref_map, tipo, serie):
     """
-    Relê todos os XML/ZIP do lote (memória da sessão ou TEMP_UPLOADS_DIR), mesmas regras de fusão por chave,
-    mantém registos manuais de inutilização e de cancelamento «sem XML» e recalcula os dataframes.
+    Ãšltimo nº guardado na lateral para modelo|série.
+    Aceita NF-e vs 55 (e restantes códigos Sefaz), série «4» ou «004», para o mapa bater com o que veio
+    da grelha, da planilha ou do XML — senão ultimo_u fica None e as notas **não entram** em nums_buraco.
     """
-    cnpj = "".join(c for c in str(cnpj_limpo or "") if c.isdigit())[:14]
-    if len(cnpj) != 14:
-        return False, "CNPJ inválido — confira a barra lateral."
+    if not ref_map:
+        return None
+    t_in = str(tipo).strip()
+    s_raw = str(serie).strip()
 
-    if not _garimpo_existem_fontes_xml_lote():
-        if _garimpo_analise_sem_pasta_local_projeto():
-            return (
-                False,
-                "Não há ficheiros do lote em memória. Faça **Iniciar grande garimpo** ou **Incluir mais XML**.",
-            )
-        return False, "Pasta de uploads não existe."
+    tipo_keys: list = []
+    seen_t = set()
 
-    nomes = _lista_nomes_fontes_xml_garimpo()
-    if not nomes:
-        return (
-            False,
-            "Nenhum ficheiro no lote. Use «Incluir mais XML / ZIP» ou inicie um novo garimpo.",
-        )
-    try:
-        if t_start is None:
-            t_start = time.time()
-        lote_dict = {}
-        total_n = len(nomes)
-        _garim_footer_render(footer_ph, 0, max(1, total_n), "—", "Início", t_start)
-        for i, f_name in enumerate(nomes):
-            _garim_footer_render(footer_ph, i + 1, total_n, f_name, "Ler", t_start)
-            try:
-                with _abrir_fonte_xml_garimpo_stream(f_name) as file_obj:
-                    todos_xmls = extrair_fonte_xml_garimpo(file_obj, f_name)
-                    _inner_xml_n = 0
-                    for name, xml_data in todos_xmls:
-                        _inner_xml_n += 1
-                        if (
-                            _inner_xml_n % _GARIM_GRANDE_GARIMPO_REFRESH_XML_A_CADA
-                            == 0
-                        ):
-                            _garim_footer_render(
-                                footer_ph,
-                                i + 1,
-                                total_n,
-                                f_name,
-                                f"{_inner_xml_n} xml · {len(lote_dict)}",
-                                t_start,
-                            )
-                        res, is_p = identify_xml_info(xml_data, cnpj, name)
-                        if res:
-                            key = res["Chave"]
-                            if key in lote_dict:
-                                if res["Status"] in [
-                                    "CANCELADOS",
-                                    "INUTILIZADOS",
-                                    "DENEGADOS",
-                                    "REJEITADOS",
-                                ]:
-                                    lote_dict[key] = (res, is_p)
-                            else:
-                                lote_dict[key] = (res, is_p)
-                        del xml_data
-            except Exception:
-                continue
-    
-        rel_disk = [t[0] for t in lote_dict.values()]
-        if not rel_disk:
-            return (
-                False,
-                "Nenhum documento reconhecido ao reler a pasta (verifique CNPJ e ficheiros). O relatório não foi alterado.",
-            )
-    
-        rel_atual = list(st.session_state.get("relatorio") or [])
-        manuais = [r for r in rel_atual if _inutil_sem_xml_manual(r) or _cancel_sem_xml_manual(r)]
-    
-        st.session_state["relatorio"] = rel_disk + manuais
-        st.session_state["export_ready"] = False
-        st.session_state["excel_buffer"] = None
-        if st.session_state.get("validation_done"):
-            st.session_state["validation_done"] = False
-        st.session_state.pop("df_divergencias", None)
-        st.session_state.pop("_xlsx_mem_geral_workbook", None)
-        st.session_state.pop("_xlsx_mem_geral_workbook_terc", None)
-        for _pfx in (
-            "rep_bur",
-            "rep_inu",
-            "rep_canc",
-            "rep_aut",
-            "rep_den",
-            "rep_rej",
-            "rep_ger",
-            "rep_canc_t",
-            "rep_aut_t",
-            "rep_den_t",
-            "rep_rej_t",
-            "rep_ger_t",
-        ):
-            st.session_state.pop(f"{_pfx}_zip_parts_ready", None)
-            st.session_state.pop(f"{_pfx}_zip_src_sig", None)
-    
-        reconstruir_dataframes_relatorio_simples()
-    
-        _n_inm = sum(1 for r in manuais if _inutil_sem_xml_manual(r))
-        _n_cam = sum(1 for r in manuais if _cancel_sem_xml_manual(r))
-        return (
-            True,
-            f"Concluído: {len(nomes)} ficheiro(s) lidos, {len(rel_disk)} documento(s) únicos; "
-            f"{len(manuais)} registo(s) manual(is) mantido(s) ({_n_inm} inutil., {_n_cam} cancel.).",
-        )
-    finally:
-        _garim_footer_overlay_remove()
+    def add_t(x):
+        if x is None:
+            return
+        x = str(x).strip()
+        if not x or x.lower() == "nan":
+            return
+        if x not in seen_t:
+            seen_t.add(x)
+            tipo_keys.append(x)
 
+    add_t(t_in)
+    t_norm = _normaliza_modelo_filtro(tipo)
+    if t_norm:
+        add_t(t_norm)
+    for _c, _lab in _MODELO_SEFAZ_PARA_RELATORIO.items():
+        if _lab == t_norm or _lab == t_in or _c == t_in:
+            add_t(_c)
+            add_t(_lab)
 
+    ser_keys: list = []
+    seen_s = set()
 
-def _relatorio_ja_tem_chave(chave: str) -> bool:
-    return any(r.get("Chave") == chave for r in (st.session_state.get("relatorio") or []))
+    def add_s(x):
+        x = str(x).strip()
+        if x in seen_s:
+            return
+        seen_s.add(x)
+        ser_keys.append(x)
 
+    add_s(s_raw)
+    if s_raw.isdigit():
+        n = int(s_raw)
+        add_s(str(n))
+        add_s(str(n).zfill(3))
 
-def processar_painel_lateral_direito(
-    cnpj_limpo: str,
-    extra_files,
-    pick_bur_inut,
-    mb_bur,
-    sb_bur,
-    up_inut_planilha,
-    mf_faixa,
-    sf_faixa,
-    n0_faixa,
-    n1_faixa,
-    pick_bur_canc=None,
-    mb_canc=None,
-    sb_canc=None,
-    up_canc_planilha=None,
-    mf_canc_f=None,
-    sf_canc_f=None,
-    n0_canc_f=None,
-    n1_canc_f=None,
-    up_autent_sefaz=None,
-    footer_ph=None,
-    t_start=None,
-    texto_inut_planilha=None,
-    texto_canc_planilha=None,
-):
+    for tb in tipo_keys:
+        for sb in ser_keys:
+            k = f"{tb}|{sb}"
+            if k in ref_map:
+                return ref_map[k]
+    return None
+
+
+def numero_entra_conjunto_buraco(ano, mes, n, ref_ar, ref_mr, ultimo_u):
     """
-    Um único passo: grava XML/ZIP extra em disco, aplica inutilizações e canceladas manuais
-    (buracos / planilha / faixa, mesmas regras), recalcula a partir do disco (ou só reconstrói)
-    e, se anexar planilha(s), compara autenticidade Sefaz Ã— XML (vários Excel/CSV são agregados).
+    Com mês de referência na sessão: ignora competências anteriores; no próprio mês só conta n > último informado;
+    meses posteriores contam. Sem ref_ar/ref_mr na chamada: o chamador trata (incluir_numero… devolve True antes).
+    Se ref está activo mas falta último nº da série, não contar.
     """
-    cnpj = "".join(c for c in str(cnpj_limpo or "") if c.isdigit())[:14]
-    linhas = []
-    n_extra = 0
-    if extra_files:
-        n_extra = _garimpo_absorver_uploads_extra_no_lote(extra_files)
-        if n_extra:
-            _lbl = (
-                "**em memória** (e/ou pasta temp, conforme configuração)"
-                if _garimpo_analise_sem_pasta_local_projeto()
-                else "**na pasta de uploads**"
-            )
-            linhas.append(f"**{n_extra}** ficheiro(s) extra incorporado(s) ao lote {_lbl}.")
+    if ref_ar is None or ref_mr is None:
+        return True
+    if str(ano) == "0000":
+        return False
+    if _ym_lt(ano, mes, ref_ar, ref_mr):
+        return False
+    if ultimo_u is None:
+        return False
+    if _ym_eq(ano, mes, ref_ar, ref_mr):
+        try:
+            return int(n) > int(ultimo_u)
+        except (TypeError, ValueError):
+            return False
+    return True
 
-    n_b = 0
-    if pick_bur_inut:
-        if mb_bur is None or sb_bur is None or str(sb_bur).strip() == "":
-            return (
-                False,
-                "Para aplicar notas em «Dos buracos», escolha **modelo** e **série** nesse separador.",
-                linhas,
-            )
-        for _nb in pick_bur_inut:
-            _it = item_registro_manual_inutilizado(cnpj_limpo, mb_bur, sb_bur, _nb)
-            if not _relatorio_ja_tem_chave(_it["Chave"]) and not _registro_manual_inutil_duplicada(
-                st.session_state["relatorio"], mb_bur, sb_bur, _nb
-            ):
-                st.session_state["relatorio"].append(_it)
-                n_b += 1
-        if n_b:
-            linhas.append(f"**{n_b}** inutilização(ões) a partir dos buracos.")
 
-    n_p = 0
-    err_p = None
-    _dfs_inut = []
-    _warns_inut = []
-    if up_inut_planilha is not None:
-        _df_up, _err_up = dataframe_de_upload_inutil(up_inut_planilha)
-        if _err_up:
-            _warns_inut.append(f"Ficheiro inutilizadas: {_err_up}")
-        elif _df_up is not None and not _df_up.empty:
-            _dfs_inut.append(_df_up)
-    if texto_inut_planilha and str(texto_inut_planilha).strip():
-        _df_pc, _err_pc = dataframe_de_texto_colar_planilha(str(texto_inut_planilha).strip())
-        if _err_pc:
-            _warns_inut.append(f"Texto colado (inutilizadas): {_err_pc}")
-        elif _df_pc is not None and not _df_pc.empty:
-            _dfs_inut.append(_df_pc)
-    if _dfs_inut:
-        _df_merged = (
-            pd.concat(_dfs_inut, ignore_index=True) if len(_dfs_inut) > 1 else _dfs_inut[0]
-        )
-        _tri, _err_tr = triplas_inutil_de_dataframe(_df_merged)
-        if _err_tr:
-            err_p = _err_tr
+def _buraco_np_unicos(nums):
+    """Números (set / lista / array) → array int64 ordenado e sem repetidos."""
+    if isinstance(nums, np.ndarray):
+        a = np.sort(nums.astype(np.int64))
+    else:
+        try:
+            a = np.fromiter(nums, dtype=np.int64, count=len(nums))
+        except (TypeError, ValueError):
+            a = np.fromiter((int(x) for x in nums), dtype=np.int64)
+        a.sort()
+    if len(a) > 1:
+        a = a[np.concatenate(([True], a[1:] != a[:-1]))]
+    return a
+
+
+def _buraco_faixas_vazias():
+    return np.zeros((0, 2), dtype=np.int64)
+
+
+def _buraco_faixas_de_numeros(ns):
+    """int64 ordenado e único → faixas (início, fim) de números seguidos."""
+    if not len(ns):
+        return _buraco_faixas_vazias()
+    quebra = np.flatnonzero(np.diff(ns) != 1)
+    ini = ns[np.concatenate(([0], quebra + 1))]
+    fim = ns[np.concatenate((quebra, [len(ns) - 1]))]
+    return np.column_stack((ini, fim))
+
+
+def _buraco_faixas_unir(*partes):
+    """Junta faixas (arrays (k, 2) ou listas de pares) numa lista ordenada, sem sobreposições nem faixas contíguas."""
+    arrs = [np.asarray(p, dtype=np.int64).reshape(-1, 2) for p in partes if len(p)]
+    if not arrs:
+        return _buraco_faixas_vazias()
+    f = np.concatenate(arrs)
+    f = f[f[:, 0] <= f[:, 1]]
+    if not len(f):
+        return _buraco_faixas_vazias()
+    f = f[np.argsort(f[:, 0], kind="stable")]
+    fim_acum = np.maximum.accumulate(f[:, 1])
+    grupos = np.flatnonzero(np.concatenate(([True], f[1:, 0] > fim_acum[:-1] + 1)))
+    ultimos = np.concatenate((grupos[1:] - 1, [len(f) - 1]))
+    return np.column_stack((f[grupos, 0], fim_acum[ultimos]))
+
+
+def _buraco_faixas_conjunto(nums=(), faixas=()):
+    """Números soltos + faixas (ex.: inutilizações nNFIni–nNFFin) → faixas unidas."""
+    pontos = _buraco_faixas_de_numeros(_buraco_np_unicos(nums)) if len(nums) else ()
+    return _buraco_faixas_unir(pontos, faixas)
+
+
+def _buraco_faixas_lacunas(cobertas, gap_max=MAX_SALTO_ENTRE_NOTAS_CONSECUTIVAS):
+    """
+    Faixas em falta entre faixas cobertas consecutivas (unidas). Saltos maiores que `gap_max` partem o trecho —
+    entre eles nada é buraco.
+    """
+    if len(cobertas) < 2:
+        return _buraco_faixas_vazias()
+    d = cobertas[1:, 0] - cobertas[:-1, 1]
+    i = np.flatnonzero((d > 1) & (d <= gap_max))
+    return np.column_stack((cobertas[i, 1] + 1, cobertas[i + 1, 0] - 1))
+
+
+def _buraco_faixas_subtrair(faixas, tirar):
+    """`faixas` menos `tirar` (ambas unidas), por varrimento dos limites — sem passar por cada número."""
+    if not len(faixas) or not len(tirar):
+        return faixas
+    kf, kt = len(faixas), len(tirar)
+    pos = np.concatenate((faixas[:, 0], faixas[:, 1] + 1, tirar[:, 0], tirar[:, 1] + 1))
+    delta = np.concatenate(
+        (np.ones(kf, np.int64), np.full(kf, -1, np.int64), np.full(kt, 2, np.int64), np.full(kt, -2, np.int64))
+    )
+    ordem = np.argsort(pos, kind="stable")
+    pos = pos[ordem]
+    nivel = np.cumsum(delta[ordem])
+    fim_grupo = np.concatenate((pos[1:] != pos[:-1], [True]))
+    pos, nivel = pos[fim_grupo], nivel[fim_grupo]
+    sel = nivel[:-1] == 1
+    return _buraco_faixas_unir(np.column_stack((pos[:-1][sel], pos[1:][sel] - 1)))
+
+
+def _buraco_faixas_intersecta(faixas, a, b) -> bool:
+    """Alguma faixa toca em [a, b]?"""
+    if faixas is None or not len(faixas) or a > b:
+        return False
+    k = int(np.searchsorted(faixas[:, 1], a, side="left"))
+    return k < len(faixas) and int(faixas[k, 0]) <= b
+
+
+def _buraco_faixas_tamanho(faixas) -> int:
+    return int((faixas[:, 1] - faixas[:, 0] + 1).sum()) if len(faixas) else 0
+
+
+def _buraco_faixas_expandir(faixas):
+    """Faixas (início, fim) → array com cada número (só quando a grelha / Excel precisa de linhas)."""
+    if not len(faixas):
+        return np.zeros(0, dtype=np.int64)
+    ini, fim = faixas[:, 0], faixas[:, 1]
+    tam = fim - ini + 1
+    desloc = np.cumsum(tam) - tam
+    return np.arange(int(tam.sum()), dtype=np.int64) + np.repeat(ini - desloc, tam)
+
+
+def _buraco_faixa_inut(ano, mes, ra, rb, ref_ar, ref_mr, ultimo_u):
+    """
+    Parte de uma inutilização [ra, rb] que entra em nums_buraco (`incluir_numero_no_conjunto_buraco`), ou None.
+    A regra só depende do nº por «n > último nº» no mês de referência (monótona): basta achar o 1.º que entra.
+    """
+    if ra > rb or not incluir_numero_no_conjunto_buraco(ano, mes, rb, ref_ar, ref_mr, ultimo_u):
+        return None
+    lo, hi = ra, rb
+    while lo < hi:
+        meio = (lo + hi) // 2
+        if incluir_numero_no_conjunto_buraco(ano, mes, meio, ref_ar, ref_mr, ultimo_u):
+            hi = meio
         else:
-            _df_bu = st.session_state["df_faltantes"].copy()
-            _bur_t = conjunto_triplas_buracos(_df_bu)
-            if not _bur_t:
-                err_p = "Não há buracos na auditoria — nada importado da planilha/texto."
-            else:
-                _aplic_rows = []
-                _ign = 0
-                _seen = set()
-                for _mod, _ser, _nota in _tri:
-                    _k = (_mod.strip(), str(_ser).strip(), int(_nota))
-                    if _k not in _bur_t:
-                        _ign += 1
-                        continue
-                    if _k in _seen:
-                        continue
-                    _seen.add(_k)
-                    _aplic_rows.append((_mod.strip(), str(_ser).strip(), int(_nota)))
-                if not _aplic_rows:
-                    err_p = "Nenhuma linha da planilha/texto coincide com buraco listado."
-                else:
-                    n_p = 0
-                    for _mod, _ser, _nota in _aplic_rows:
-                        _itp = item_registro_manual_inutilizado(cnpj_limpo, _mod, _ser, _nota)
-                        if not _relatorio_ja_tem_chave(_itp["Chave"]) and not _registro_manual_inutil_duplicada(
-                            st.session_state["relatorio"], _mod, _ser, _nota
-                        ):
-                            st.session_state["relatorio"].append(_itp)
-                            n_p += 1
-                    if n_p:
-                        linhas.append(f"**{n_p}** linha(s) da planilha/texto (buracos).")
-                    elif _aplic_rows:
-                        linhas.append("Planilha/texto: linhas já presentes no relatório (sem duplicar).")
-                    if _ign > 0:
-                        linhas.append(f"({_ign} linha(s) ignoradas — não eram buraco.)")
-        if _warns_inut:
-            linhas.append("**Aviso:** " + " ".join(_warns_inut))
-    elif _warns_inut:
-        err_p = " ".join(_warns_inut)
+            lo = meio + 1
+    return (lo, rb)
 
-    _MAX_FAIXA_INUT = 5000
-    n_f = 0
-    err_f = None
-    df_fb = st.session_state["df_faltantes"].copy()
-    if not df_fb.empty and "Serie" in df_fb.columns and "Série" not in df_fb.columns:
-        df_fb = df_fb.rename(columns={"Serie": "Série"})
-    _bur_f = set()
-    if (
-        not df_fb.empty
-        and {"Tipo", "Série", "Num_Faltante"}.issubset(df_fb.columns)
-    ):
-        _subf = df_fb[
-            (df_fb["Tipo"].astype(str) == mf_faixa)
-            & (df_fb["Série"].astype(str) == str(sf_faixa).strip())
-        ]
-        _bur_f = set(_subf["Num_Faltante"].astype(int).unique())
-    if not sf_faixa or not str(sf_faixa).strip():
-        pass
-    elif n0_faixa > n1_faixa:
-        err_f = "Faixa: a nota inicial não pode ser maior que a final."
-    elif (n1_faixa - n0_faixa + 1) > _MAX_FAIXA_INUT:
-        err_f = f"Faixa: máximo {_MAX_FAIXA_INUT} notas."
-    elif not _bur_f:
-        err_f = "Faixa: não há buracos para este modelo/série."
+
+def faixas_buraco_por_serie(
+    nums_buraco,
+    ultimo_u,
+    gap_max=MAX_SALTO_ENTRE_NOTAS_CONSECUTIVAS,
+    nums_existentes=None,
+    faixas_buraco=(),
+    faixas_existentes=(),
+):
+    """
+    Mesmos buracos que `falhas_buraco_por_serie`, em faixas: array int64 (k, 2) de (início, fim) inclusivos,
+    ordenado. Não cria uma linha por número — ver `_buraco_faixas_expandir` / `df_faltantes_de_faixas`.
+    `faixas_buraco` / `faixas_existentes` somam faixas inteiras (inutilizações) aos números soltos.
+    """
+    vazio = _buraco_faixas_vazias()
+    cobertas = _buraco_faixas_conjunto(nums_buraco, faixas_buraco)
+    if not len(cobertas):
+        return vazio
+    U = None
+    if ultimo_u is not None:
+        try:
+            U = int(ultimo_u)
+        except (TypeError, ValueError):
+            U = None
+    if U is not None:
+        cobertas = cobertas[cobertas[:, 1] > U]
+        if not len(cobertas):
+            return vazio
+        cobertas[0, 0] = max(int(cobertas[0, 0]), U + 1)
+        faixas = _buraco_faixas_lacunas(cobertas, gap_max)
+        if cobertas[0, 0] > U + 1:
+            faixas = np.vstack(([[U + 1, cobertas[0, 0] - 1]], faixas))
     else:
-        _aplic = [n for n in range(int(n0_faixa), int(n1_faixa) + 1) if n in _bur_f]
-        if _aplic:
-            n_f = 0
-            for _nn in _aplic:
-                _itf = item_registro_manual_inutilizado(
-                    cnpj_limpo, mf_faixa, str(sf_faixa).strip(), _nn
-                )
-                if not _relatorio_ja_tem_chave(_itf["Chave"]) and not _registro_manual_inutil_duplicada(
-                    st.session_state["relatorio"], mf_faixa, str(sf_faixa).strip(), _nn
-                ):
-                    st.session_state["relatorio"].append(_itf)
-                    n_f += 1
-            if n_f:
-                linhas.append(f"**{n_f}** nota(s) da faixa (buracos).")
+        faixas = _buraco_faixas_lacunas(cobertas, gap_max)
+    if (nums_existentes is not None and len(nums_existentes)) or len(faixas_existentes):
+        try:
+            ex = _buraco_faixas_conjunto(nums_existentes if nums_existentes is not None else (), faixas_existentes)
+        except (TypeError, ValueError, OverflowError):
+            ex = None
+        if ex is not None:
+            faixas = _buraco_faixas_subtrair(faixas, ex)
+    return faixas
+
+
+def df_faltantes_de_faixas(blocos) -> pd.DataFrame:
+    """Tabela de buracos (Tipo, Série, Num_Faltante) a partir de [(tipo, série, faixas)], pela ordem dada."""
+    rotulos, nums = [], []
+    for tipo, serie, faixas in blocos:
+        ns = _buraco_faixas_expandir(faixas)
+        if len(ns):
+            rotulos.append((tipo, serie, len(ns)))
+            nums.append(ns)
+    if not nums:
+        return pd.DataFrame([])
+    qtd = [q for _t, _s, q in rotulos]
+    return pd.DataFrame(
+        {
+            "Tipo": np.repeat(_relatorio_objetos([t for t, _s, _q in rotulos]), qtd),
+            "Série": np.repeat(_relatorio_objetos([s for _t, s, _q in rotulos]), qtd),
+            "Num_Faltante": np.concatenate(nums),
+        }
+    )
 
-    pick_bc = list(pick_bur_canc or [])
-    n_b_c = 0
-    if pick_bc:
-        if mb_canc is None or sb_canc is None or str(sb_canc).strip() == "":
-            return (
-                False,
-                "Para aplicar canceladas em «Dos buracos», escolha **modelo** e **série** nesse separador.",
-                linhas,
-            )
-        for _nb in pick_bc:
-            _itc = item_registro_manual_cancelado(cnpj_limpo, mb_canc, sb_canc, _nb)
-            if not _relatorio_ja_tem_chave(_itc["Chave"]) and not _registro_manual_cancel_duplicada(
-                st.session_state["relatorio"], mb_canc, sb_canc, _nb
-            ):
-                st.session_state["relatorio"].append(_itc)
-                n_b_c += 1
-        if n_b_c:
-            linhas.append(f"**{n_b_c}** cancelada(s) a partir dos buracos.")
 
-    n_p_c = 0
-    err_p_c = None
-    _dfs_canc = []
-    _warns_canc = []
-    if up_canc_planilha is not None:
-        _df_uc, _err_uc = dataframe_de_upload_inutil(up_canc_planilha)
-        if _err_uc:
-            _warns_canc.append(f"Ficheiro canceladas: {_err_uc}")
-        elif _df_uc is not None and not _df_uc.empty:
-            _dfs_canc.append(_df_uc)
-    if texto_canc_planilha and str(texto_canc_planilha).strip():
-        _df_cc, _err_cc = dataframe_de_texto_colar_planilha(str(texto_canc_planilha).strip())
-        if _err_cc:
-            _warns_canc.append(f"Texto colado (canceladas): {_err_cc}")
-        elif _df_cc is not None and not _df_cc.empty:
-            _dfs_canc.append(_df_cc)
-    if _dfs_canc:
-        _df_cmerged = (
-            pd.concat(_dfs_canc, ignore_index=True) if len(_dfs_canc) > 1 else _dfs_canc[0]
-        )
-        _trc, _err_trc = triplas_inutil_de_dataframe(_df_cmerged)
-        if _err_trc:
-            err_p_c = _err_trc
-        else:
-            _df_buc = st.session_state["df_faltantes"].copy()
-            _bur_tc = conjunto_triplas_buracos(_df_buc)
-            if not _bur_tc:
-                err_p_c = "Canceladas — não há buracos na auditoria — nada importado da planilha/texto."
-            else:
-                _aplic_c = []
-                _ign_c = 0
-                _seen_c = set()
-                for _mod, _ser, _nota in _trc:
-                    _k = (_mod.strip(), str(_ser).strip(), int(_nota))
-                    if _k not in _bur_tc:
-                        _ign_c += 1
-                        continue
-                    if _k in _seen_c:
-                        continue
-                    _seen_c.add(_k)
-                    _aplic_c.append((_mod.strip(), str(_ser).strip(), int(_nota)))
-                if not _aplic_c:
-                    err_p_c = "Canceladas — nenhuma linha da planilha/texto coincide com buraco listado."
-                else:
-                    for _mod, _ser, _nota in _aplic_c:
-                        _itpc = item_registro_manual_cancelado(cnpj_limpo, _mod, _ser, _nota)
-                        if not _relatorio_ja_tem_chave(_itpc["Chave"]) and not _registro_manual_cancel_duplicada(
-                            st.session_state["relatorio"], _mod, _ser, _nota
-                        ):
-                            st.session_state["relatorio"].append(_itpc)
-                            n_p_c += 1
-                    if n_p_c:
-                        linhas.append(f"**{n_p_c}** linha(s) da planilha/texto de **canceladas** (buracos).")
-                    elif _aplic_c:
-                        linhas.append("Planilha/texto canceladas: linhas já presentes no relatório (sem duplicar).")
-                    if _ign_c > 0:
-                        linhas.append(f"({_ign_c} linha(s) ignoradas nas canceladas — não eram buraco.)")
-        if _warns_canc:
-            linhas.append("**Aviso:** " + " ".join(_warns_canc))
-    elif _warns_canc:
-        err_p_c = " ".join(_warns_canc)
+def falhas_buraco_por_serie(
+    nums_buraco,
+    tipo_doc,
+    serie_str,
+    ultimo_u,
+    gap_max=MAX_SALTO_ENTRE_NOTAS_CONSECUTIVAS,
+    nums_existentes=None,
+):
+    """
+    Buracos a partir do último nº informado (se houver): preenche o intervalo até ao primeiro nº relevante nos XMLs
+    e mantém a lógica de trechos (saltos grandes) no restante.
+
+    nums_existentes: todos os nº já lidos no lote para (tipo, série) — notas que não entram em nums_buraco por causa
+    do mês/«último nº» na lateral continuam aqui; sem este filtro apareciam como «buraco» embora o XML existisse.
+    Uma linha por número; o cálculo é feito em faixas (`faixas_buraco_por_serie`).
+    """
+    faixas = faixas_buraco_por_serie(nums_buraco, ultimo_u, gap_max, nums_existentes)
+    return [
+        {"Tipo": tipo_doc, "Série": serie_str, "Num_Faltante": b}
+        for b in _buraco_faixas_expandir(faixas).tolist()
+    ]
+
+
+# Grelha «Ãºltimo nÂº por sÃ©rie» (sidebar): nomes canÃ³nicos e aliases (sessÃ£o / encoding).
+SEQ_REF_COL_MODELO = "Modelo"
+SEQ_REF_COL_SERIE = "Série"
+SEQ_REF_COL_ULT = "Último número"
+SEQ_REF_COLS_ORDER = (SEQ_REF_COL_MODELO, SEQ_REF_COL_SERIE, SEQ_REF_COL_ULT)
+
+
+def _seq_ref_fold(name):
+    """Normaliza cabeçalho para comparação (acentos, espaços)."""
+    t = unicodedata.normalize("NFKC", str(name)).strip()
+    t = "".join(
+        c for c in unicodedata.normalize("NFD", t) if unicodedata.category(c) != "Mn"
+    )
+    t = re.sub(r"\s+", "", t)
+    return t.casefold()
+
+
+def _match_seq_ref_column(name):
+    """Mapeia um cabeçalho de coluna para SEQ_REF_COL_* ou None."""
+    raw = str(name).strip()
+    f = _seq_ref_fold(raw)
+    if f == "modelo":
+        return SEQ_REF_COL_MODELO
+    if f in ("serie", "srie"):
+        return SEQ_REF_COL_SERIE
+    if f in ("ultimonumero", "ltimonumero", "ultimon", "ultimon.", "ult.n", "ult.n."):
+        return SEQ_REF_COL_ULT
+    if f.startswith("ltimo") and "num" in f:
+        return SEQ_REF_COL_ULT
+    if "ultimo" in f and "num" in f:
+        return SEQ_REF_COL_ULT
+    return None
+
+
+def _normalize_seq_ref_df_columns(df):
+    """Renomeia aliases (Serie, Srie, ltimo nº, etc.) para os nomes canónicos."""
+    if df is None or df.empty:
+        return df
+    if all(c in df.columns for c in SEQ_REF_COLS_ORDER):
+        return df
+    rename = {}
+    used = set()
+    for c in df.columns:
+        target = _match_seq_ref_column(c)
+        if target is None or target in used:
+            continue
+        rename[c] = target
+        used.add(target)
+    if rename:
+        df = df.rename(columns=rename)
+    return df
+
+
+def ultimos_dict_para_dataframe(ultimos_dict):
+    if not ultimos_dict:
+        return pd.DataFrame(columns=list(SEQ_REF_COLS_ORDER))
+    rows = []
+    for kstr, v in ultimos_dict.items():
+        if "|" not in kstr:
+            continue
+        a, b = kstr.split("|", 1)
+        rows.append(
+            {
+                SEQ_REF_COL_MODELO: a.strip(),
+                SEQ_REF_COL_SERIE: b.strip(),
+                SEQ_REF_COL_ULT: int(v),
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+def ref_map_from_dataframe(df):
+    """Monta o mapa 'Modelo|Série' -> último a partir da tabela do editor."""
+    out = {}
+    if df is None or df.empty:
+        return out
+    df = _normalize_seq_ref_df_columns(df)
+    for _, row in df.iterrows():
+        modelo = row.get(SEQ_REF_COL_MODELO)
+        if modelo is None or pd.isna(modelo):
+            continue
+        modelo = str(modelo).strip()
+        if not modelo or modelo.lower() == "nan":
+            continue
+        serie = row.get(SEQ_REF_COL_SERIE)
+        if serie is None or pd.isna(serie):
+            serie = ""
+        else:
+            serie = str(serie).strip()
+        if not serie:
+            continue
+        ult = row.get(SEQ_REF_COL_ULT)
+        if ult is None or pd.isna(ult):
+            continue
+        if isinstance(ult, str):
+            d = "".join(filter(str.isdigit, ult.strip()))
+            if not d:
+                continue
+            try:
+                u = int(d)
+            except ValueError:
+                continue
+        else:
+            try:
+                u = int(float(ult))
+            except (TypeError, ValueError):
+                continue
+        if u <= 0:
+            continue
+        out[f"{modelo}|{serie}"] = u
+    return out
+
+
+def normalize_seq_ref_editor_df(df):
+    """Prepara a grelha: último nº em texto (evita float/NaN do NumberColumn que some ao recarregar)."""
+    cols = list(SEQ_REF_COLS_ORDER)
+    if df is None or df.empty:
+        return pd.DataFrame(columns=cols)
+
+    df = _normalize_seq_ref_df_columns(df)
+
+    def _str_model(x):
+        if x is None or pd.isna(x):
+            return None
+        s = str(x).strip()
+        return s if s and s.lower() != "nan" else None
+
+    def _str_ser(x):
+        if x is None or pd.isna(x):
+            return ""
+        return str(x).strip()
+
+    def _ult_txt(x):
+        if x is None or pd.isna(x):
+            return ""
+        if isinstance(x, bool):
+            return ""
+        if isinstance(x, int):
+            return str(x) if x >= 0 else ""
+        if isinstance(x, float):
+            try:
+                if pd.isna(x):
+                    return ""
+                return str(int(x))
+            except (ValueError, OverflowError):
+                return ""
+        return "".join(filter(str.isdigit, str(x)))
+
+    out = df.reindex(columns=cols).copy()
+    out[SEQ_REF_COL_MODELO] = out[SEQ_REF_COL_MODELO].map(_str_model)
+    out[SEQ_REF_COL_SERIE] = out[SEQ_REF_COL_SERIE].map(_str_ser)
+    out[SEQ_REF_COL_ULT] = out[SEQ_REF_COL_ULT].map(_ult_txt)
+    return out
+
+
+def collect_seq_ref_from_widgets(struct_v: int, n_rows: int, default_modelo: str = "NF-e") -> pd.DataFrame:
+    """Lê select/text da sidebar (chaves sr_{v}_{i}_*) e devolve DataFrame normalizado."""
+    recs = []
+    for i in range(n_rows):
+        recs.append(
+            {
+                "Modelo": st.session_state.get(f"sr_{struct_v}_{i}_m", default_modelo),
+                "Série": str(st.session_state.get(f"sr_{struct_v}_{i}_s", "") or ""),
+                SEQ_REF_COL_ULT: str(st.session_state.get(f"sr_{struct_v}_{i}_u", "") or ""),
+            }
+        )
+    return normalize_seq_ref_editor_df(pd.DataFrame(recs))
+
+
+def item_registro_manual_inutilizado(cnpj_limpo, tipo_man, serie_man, nota_man):
+    serie_str = str(serie_man).strip()
+    return {
+        "Arquivo": "REGISTRO_MANUAL",
+        "Chave": f"MANUAL_INUT_{tipo_man}_{serie_str}_{nota_man}",
+        "Tipo": tipo_man,
+        "Série": serie_str,
+        "Número": int(nota_man),
+        "Status": "INUTILIZADOS",
+        "Pasta": f"EMITIDOS_CLIENTE/SAIDA/{tipo_man}/INUTILIZADOS/0000/01/Serie_{serie_str}",
+        "Valor": 0.0,
+        "Conteúdo": b"",
+        "Ano": "0000",
+        "Mes": "01",
+        "Operacao": "SAIDA",
+        "Data_Emissao": "",
+        "CNPJ_Emit": cnpj_limpo,
+        "Nome_Emit": "INSERÇÃO MANUAL",
+        "Doc_Dest": "",
+        "Nome_Dest": "",
+    }
+
+
+def item_registro_manual_cancelado(cnpj_limpo, tipo_man, serie_man, nota_man):
+    """Cancelamento declarado sem XML de evento (mesmas regras de buraco que inutilizada manual)."""
+    serie_str = str(serie_man).strip()
+    return {
+        "Arquivo": "REGISTRO_MANUAL_CANCELADO",
+        "Chave": f"MANUAL_CANC_{tipo_man}_{serie_str}_{nota_man}",
+        "Tipo": tipo_man,
+        "Série": serie_str,
+        "Número": int(nota_man),
+        "Status": "CANCELADOS",
+        "Pasta": f"EMITIDOS_CLIENTE/SAIDA/{tipo_man}/CANCELADOS/0000/01/Serie_{serie_str}",
+        "Valor": 0.0,
+        "Conteúdo": b"",
+        "Ano": "0000",
+        "Mes": "01",
+        "Operacao": "SAIDA",
+        "Data_Emissao": "",
+        "CNPJ_Emit": cnpj_limpo,
+        "Nome_Emit": "INSERÇÃO MANUAL",
+        "Doc_Dest": "",
+        "Nome_Dest": "",
+    }
+
+
+def _inutil_sem_xml_manual(res):
+    """Inutilização declarada manualmente (sem XML de inutilização)."""
+    if str(res.get("Chave") or "").startswith("MANUAL_INUT_"):
+        return True
+    return res.get("Arquivo") == "REGISTRO_MANUAL" and res.get("Status") == "INUTILIZADOS"
+
+
+def _cancel_sem_xml_manual(res):
+    """Cancelamento declarado manualmente (sem XML de cancelamento)."""
+    if str(res.get("Chave") or "").startswith("MANUAL_CANC_"):
+        return True
+    return res.get("Arquivo") == "REGISTRO_MANUAL_CANCELADO" and res.get("Status") == "CANCELADOS"
+
+
+# --- RELATÓRIO EM COLUNAS (st.session_state["relatorio"]) ---
+# Um dict por documento custa ~1,5 KB só em estrutura; com centenas de milhares de XML o relatório pesava mais
+# que as tabelas. Os documentos lidos (formato de `identify_xml_info`) ficam em colunas: texto repetido
+# (Tipo, Série, Status, Pasta, Ano, Mes, UF, emitente…) como códigos num `array` + lista de valores únicos,
+# Número / Valor em arrays numéricos, Chave / Arquivo em listas. O que não segue esse formato (registos
+# manuais, itens de versões antigas) fica como dict — na própria linha (`literais`) ou, se entrou depois da
+# leitura, na cauda `manuais`, sempre no fim. Leitura só por `_relatorio_iter`, `_relatorio_len` & c.;
+# as funções aceitam também a lista de dicts antiga.
+_RELATORIO_CAMPOS = (
+    "Arquivo",
+    "Chave",
+    "Tipo",
+    "Série",
+    "Número",
+    "Status",
+    "Pasta",
+    "Valor",
+    "Conteúdo",
+    "Ano",
+    "Mes",
+    "Operacao",
+    "Data_Emissao",
+    "CNPJ_Emit",
+    "Nome_Emit",
+    "Doc_Dest",
+    "Nome_Dest",
+    "UF_Dest",
+)
+_RELATORIO_CAMPOS_COM_FAIXA = _RELATORIO_CAMPOS + ("Range",)
+_RELATORIO_CAMPOS_TEXTO = ("Arquivo", "Chave")
+_RELATORIO_CAMPOS_CAT = (
+    "Tipo",
+    "Série",
+    "Status",
+    "Pasta",
+    "Ano",
+    "Mes",
+    "Operacao",
+    "Data_Emissao",
+    "CNPJ_Emit",
+    "Nome_Emit",
+    "Doc_Dest",
+    "Nome_Dest",
+    "UF_Dest",
+)
+_RELATORIO_STATUS_SUBSTITUI = frozenset({"CANCELADOS", "INUTILIZADOS", "DENEGADOS", "REJEITADOS"})
+
+
+def _relatorio_e_colunar(rel) -> bool:
+    return isinstance(rel, dict) and rel.get("_colunar") == 1
+
+
+_RELATORIO_NP_TIPOS = {"b": np.int8, "h": np.int16, "i": np.int32, "q": np.int64, "d": np.float64}
+
+
+def _relatorio_np(arr):
+    """Vista NumPy (sem cópia) de uma coluna `array`."""
+    tipo = _RELATORIO_NP_TIPOS[arr.typecode]
+    return np.frombuffer(arr, dtype=tipo) if len(arr) else np.zeros(0, dtype=tipo)
+
+
+def _relatorio_item_no_formato(item) -> bool:
+    """Documento tal como sai de `identify_xml_info` — vai para as colunas; o resto fica como dict."""
+    try:
+        ks = tuple(item)
+        if ks != _RELATORIO_CAMPOS and ks != _RELATORIO_CAMPOS_COM_FAIXA:
+            return False
+        if type(item["Conteúdo"]) is not bytes or item["Conteúdo"]:
+            return False
+        n = item["Número"]
+        if type(n) is not int or not -(1 << 63) <= n < (1 << 63) or type(item["Valor"]) is not float:
+            return False
+        for c in _RELATORIO_CAMPOS_TEXTO + _RELATORIO_CAMPOS_CAT:
+            if type(item[c]) is not str:
+                return False
+        if len(ks) > len(_RELATORIO_CAMPOS):
+            r = item["Range"]
+            if type(r) is not tuple or len(r) != 2 or type(r[0]) is not int or type(r[1]) is not int:
+                return False
+    except (TypeError, KeyError, AttributeError):
+        return False
+    if item["Arquivo"] in ("REGISTRO_MANUAL", "REGISTRO_MANUAL_CANCELADO"):
+        return False
+    return not (_inutil_sem_xml_manual(item) or _cancel_sem_xml_manual(item))
+
+
+def _relatorio_colunar_de_itens(itens, manuais=()) -> dict:
+    """Relatório em colunas com os documentos `itens` (pela ordem) e a cauda `manuais`."""
+    texto = {c: [] for c in _RELATORIO_CAMPOS_TEXTO}
+    codigos = {c: array("i") for c in _RELATORIO_CAMPOS_CAT}
+    valores = {c: [] for c in _RELATORIO_CAMPOS_CAT}
+    indices = {c: {} for c in _RELATORIO_CAMPOS_CAT}
+    numero = array("q")
+    valor = array("d")
+    faixas = {}
+    literais = {}
+    n = 0
+    for item in itens:
+        if _relatorio_item_no_formato(item):
+            for c in _RELATORIO_CAMPOS_TEXTO:
+                texto[c].append(item[c])
+            for c in _RELATORIO_CAMPOS_CAT:
+                v = item[c]
+                idx = indices[c]
+                cod = idx.get(v)
+                if cod is None:
+                    cod = idx[v] = len(valores[c])
+                    valores[c].append(v)
+                codigos[c].append(cod)
+            numero.append(item["Número"])
+            valor.append(item["Valor"])
+            if "Range" in item:
+                faixas[n] = item["Range"]
+        else:
+            literais[n] = item
+            for c in _RELATORIO_CAMPOS_TEXTO:
+                texto[c].append(item.get(c))
+            for c in _RELATORIO_CAMPOS_CAT:
+                codigos[c].append(-1)
+            numero.append(0)
+            valor.append(0.0)
+        n += 1
+    for c in _RELATORIO_CAMPOS_CAT:
+        nv = len(valores[c])
+        tc = "b" if nv < 0x80 else "h" if nv < 0x8000 else "i"
+        if tc != "i":
+            codigos[c] = array(tc, codigos[c])
+    return {
+        "_colunar": 1,
+        "n": n,
+        "texto": texto,
+        "codigos": codigos,
+        "valores": valores,
+        "numero": numero,
+        "valor": valor,
+        "faixas": faixas,
+        "literais": literais,
+        "manuais": list(manuais),
+        "assinatura": None,
+    }
+
+
+def _relatorio_colunar_de_lista(itens) -> dict:
+    """Converte a lista de dicts: os registos fora do formato no fim da lista passam à cauda `manuais`."""
+    if _relatorio_e_colunar(itens):
+        return itens
+    itens = list(itens or [])
+    corte = len(itens)
+    while corte > 0 and not _relatorio_item_no_formato(itens[corte - 1]):
+        corte -= 1
+    return _relatorio_colunar_de_itens(itens[:corte], itens[corte:])
+
+
+def _relatorio_linha(rel, i):
+    """Item `i` do relatório como dict (as colunas voltam ao formato de `identify_xml_info`)."""
+    if not _relatorio_e_colunar(rel):
+        return rel[i]
+    if i >= rel["n"]:
+        return rel["manuais"][i - rel["n"]]
+    lit = rel["literais"].get(i)
+    if lit is not None:
+        return lit
+    texto, cod, val = rel["texto"], rel["codigos"], rel["valores"]
+    d = {}
+    for c in _RELATORIO_CAMPOS:
+        if c in cod:
+            d[c] = val[c][cod[c][i]]
+        elif c in texto:
+            d[c] = texto[c][i]
+        elif c == "Número":
+            d[c] = rel["numero"][i]
+        elif c == "Valor":
+            d[c] = rel["valor"][i]
+        else:
+            d[c] = b""
+    faixa = rel["faixas"].get(i)
+    if faixa is not None:
+        d["Range"] = faixa
+    return d
+
+
+def _relatorio_len(rel) -> int:
+    if _relatorio_e_colunar(rel):
+        return rel["n"] + len(rel["manuais"])
+    return len(rel or [])
+
+
+def _relatorio_iter(rel):
+    """Todos os itens do relatório, pela ordem, como dicts."""
+    if not _relatorio_e_colunar(rel):
+        yield from rel or []
+        return
+    for i in range(rel["n"]):
+        yield _relatorio_linha(rel, i)
+    yield from rel["manuais"]
+
+
+def _relatorio_iter_especiais(rel):
+    """Só os itens guardados como dict (registos manuais e afins); na lista antiga, todos."""
+    if not _relatorio_e_colunar(rel):
+        yield from rel or []
+        return
+    for i in sorted(rel["literais"]):
+        yield rel["literais"][i]
+    yield from rel["manuais"]
+
+
+def _relatorio_anexar(rel, item):
+    """Acrescenta no fim (na cauda `manuais` do relatório em colunas)."""
+    if _relatorio_e_colunar(rel):
+        rel["manuais"].append(item)
+    else:
+        rel.append(item)
+
+
+def _relatorio_tem_chave(rel, chave) -> bool:
+    if not _relatorio_e_colunar(rel):
+        return any(r.get("Chave") == chave for r in (rel or []))
+    return chave in rel["texto"]["Chave"] or any(r.get("Chave") == chave for r in rel["manuais"])
+
+
+def _relatorio_sem_chaves(rel, chaves):
+    """Cópia do relatório sem os itens cuja Chave está em `chaves` (as colunas são partilhadas se não mudarem)."""
+    if not _relatorio_e_colunar(rel):
+        return [x for x in (rel or []) if x["Chave"] not in chaves]
+    manuais = [x for x in rel["manuais"] if x["Chave"] not in chaves]
+    if any(k in chaves for k in rel["texto"]["Chave"]):
+        docs = (_relatorio_linha(rel, i) for i in range(rel["n"]))
+        return _relatorio_colunar_de_itens((x for x in docs if x["Chave"] not in chaves), manuais)
+    novo = dict(rel)
+    novo["manuais"] = manuais
+    return novo
+
+
+def _relatorio_assinatura_docs(rel) -> str:
+    """Resumo dos documentos em colunas (sem a cauda `manuais`) — igual enquanto o lote lido não mudar."""
+    if rel.get("assinatura") is None:
+        h = hashlib.blake2b(digest_size=16)
+        h.update(str(rel["n"]).encode())
+        for c in _RELATORIO_CAMPOS_TEXTO:
+            h.update("\x1f".join(map(str, rel["texto"][c])).encode("utf-8", "surrogatepass"))
+        for c in _RELATORIO_CAMPOS_CAT:
+            h.update(repr(rel["valores"][c]).encode("utf-8", "surrogatepass"))
+            h.update(rel["codigos"][c].typecode.encode())
+            h.update(rel["codigos"][c].tobytes())
+        h.update(rel["numero"].tobytes())
+        h.update(rel["valor"].tobytes())
+        h.update(repr(sorted(rel["faixas"].items())).encode())
+        h.update(repr(sorted(rel["literais"].items(), key=lambda kv: kv[0])).encode("utf-8", "surrogatepass"))
+        rel["assinatura"] = h.hexdigest()
+    return rel["assinatura"]
+
+
+def _relatorio_contagem_pares(rel, campo_a, campo_b) -> Counter:
+    """Counter {(valor de campo_a, valor de campo_b): n.º de itens} — nas colunas, sem montar dicts."""
+    cont = Counter()
+    if _relatorio_e_colunar(rel) and rel["n"]:
+        ca = _relatorio_np(rel["codigos"][campo_a]).astype(np.int64)
+        cb = _relatorio_np(rel["codigos"][campo_b]).astype(np.int64)
+        ok = ca >= 0
+        va, vb = rel["valores"][campo_a], rel["valores"][campo_b]
+        nb = max(len(vb), 1)
+        pares, qtd = np.unique(ca[ok] * nb + cb[ok], return_counts=True)
+        for p, q in zip(pares.tolist(), qtd.tolist()):
+            cont[(va[p // nb], vb[p % nb])] += q
+    for item in _relatorio_iter_especiais(rel):
+        cont[(item.get(campo_a), item.get(campo_b))] += 1
+    return cont
+
+
+def _registro_manual_inutil_duplicada(relatorio, tipo, serie_str, nota_int):
+    """Já existe **inutilização** manual (sem XML) para o mesmo modelo/série/nota — não misturar com canceladas."""
+    ser = str(serie_str).strip()
+    for r in _relatorio_iter_especiais(relatorio):
+        if not _inutil_sem_xml_manual(r):
+            continue
+        if str(r.get("Tipo") or "").strip() != str(tipo).strip():
+            continue
+        if str(r.get("Série") or "").strip() != ser:
+            continue
+        try:
+            if int(r.get("Número") or 0) != int(nota_int):
+                continue
+        except (TypeError, ValueError):
+            continue
+        return True
+    return False
+
+
+def _registro_manual_cancel_duplicada(relatorio, tipo, serie_str, nota_int):
+    """Já existe **cancelamento** manual (sem XML) para o mesmo modelo/série/nota — independente das inutilizadas."""
+    ser = str(serie_str).strip()
+    for r in _relatorio_iter_especiais(relatorio):
+        if not _cancel_sem_xml_manual(r):
+            continue
+        if str(r.get("Tipo") or "").strip() != str(tipo).strip():
+            continue
+        if str(r.get("Série") or "").strip() != ser:
+            continue
+        try:
+            if int(r.get("Número") or 0) != int(nota_int):
+                continue
+        except (TypeError, ValueError):
+            continue
+        return True
+    return False
+
+
+def _relatorio_lista_ja_tem_chave(relatorio_list, chave: str) -> bool:
+    return _relatorio_tem_chave(relatorio_list, chave)
+
+
+def _garimpo_aplicar_planilhas_inutil_cancel_no_relatorio(
+    rel_list: list,
+    cnpj_limpo: str,
+    df_faltantes: pd.DataFrame,
+    up_inut,
+    up_canc,
+    texto_inut_colar=None,
+) -> dict:
+    """
+    Primeiro garimpo: mesmas planilhas que na lateral — só (modelo, série, nota) que coincidem com buracos
+    em df_faltantes (calculados só com os XML). Vários ficheiros por tipo são lidos e agregados.
+    Opcionalmente aceita **texto colado** da grelha Sefaz / Excel (como no painel após a análise).
+    """
+    out = {"inut": 0, "canc": 0, "msgs": []}
+    bur = conjunto_triplas_buracos(df_faltantes)
+
+    def _merge_uploads(up, label):
+        if up is None:
+            return None
+        files = list(up) if isinstance(up, (list, tuple)) else [up]
+        files = [f for f in files if f is not None]
+        if not files:
+            return None
+        dfs_valid = []
+        for f in files:
+            nome = getattr(f, "name", "") or "sem_nome"
+            df, err = dataframe_de_upload_inutil(f)
+            if err:
+                out["msgs"].append(f"**{label}** (`{nome}`): {err}")
+                continue
+            if df is not None and not df.empty:
+                dfs_valid.append(df)
+        if not dfs_valid:
+            return None
+        return pd.concat(dfs_valid, ignore_index=True) if len(dfs_valid) > 1 else dfs_valid[0]
+
+    dfs_inut = []
+    merged_i_up = _merge_uploads(up_inut, "Inutilizadas")
+    if merged_i_up is not None:
+        dfs_inut.append(merged_i_up)
+    if texto_inut_colar and str(texto_inut_colar).strip():
+        _df_pc, _err_pc = dataframe_de_texto_colar_planilha(str(texto_inut_colar).strip())
+        if _err_pc:
+            out["msgs"].append(f"**Inutilizadas** (texto colado): {_err_pc}")
+        elif _df_pc is not None and not _df_pc.empty:
+            dfs_inut.append(_df_pc)
+    merged_i = (
+        pd.concat(dfs_inut, ignore_index=True) if len(dfs_inut) > 1 else (dfs_inut[0] if dfs_inut else None)
+    )
+    if merged_i is not None:
+        tri, err_tr = triplas_inutil_de_dataframe(merged_i)
+        if err_tr:
+            out["msgs"].append(f"**Inutilizadas** (planilhas combinadas): {err_tr}")
+        elif not bur:
+            out["msgs"].append(
+                "**Inutilizadas:** após os XML não há buracos na auditoria — nada importado "
+                "(como na lateral: só linhas que batam com **buraco**)."
+            )
+        else:
+            _seen = set()
+            _ign = 0
+            for _mod, _ser, _nota in tri:
+                _k = (_mod.strip(), str(_ser).strip(), int(_nota))
+                if _k not in bur:
+                    _ign += 1
+                    continue
+                if _k in _seen:
+                    continue
+                _seen.add(_k)
+                _itp = item_registro_manual_inutilizado(cnpj_limpo, _mod, _ser, _nota)
+                if not _relatorio_lista_ja_tem_chave(rel_list, _itp["Chave"]) and not _registro_manual_inutil_duplicada(
+                    rel_list, _mod, _ser, _nota
+                ):
+                    _relatorio_anexar(rel_list, _itp)
+                    out["inut"] += 1
+            if out["inut"] == 0 and tri:
+                out["msgs"].append(
+                    "**Inutilizadas:** nenhuma linha coincidiu com buraco (ou já existia no relatório)."
+                )
+            if _ign > 0:
+                out["msgs"].append(f"**Inutilizadas:** {_ign} linha(s) ignoradas (não eram buraco).")
+
+    merged_c = _merge_uploads(up_canc, "Canceladas")
+    if merged_c is not None:
+        trc, err_trc = triplas_inutil_de_dataframe(merged_c)
+        if err_trc:
+            out["msgs"].append(f"**Canceladas** (planilhas combinadas): {err_trc}")
+        elif not bur:
+            out["msgs"].append(
+                "**Canceladas:** após os XML não há buracos na auditoria — nada importado da planilha."
+            )
+        else:
+            _seen_c = set()
+            _ign_c = 0
+            for _mod, _ser, _nota in trc:
+                _k = (_mod.strip(), str(_ser).strip(), int(_nota))
+                if _k not in bur:
+                    _ign_c += 1
+                    continue
+                if _k in _seen_c:
+                    continue
+                _seen_c.add(_k)
+                _itpc = item_registro_manual_cancelado(cnpj_limpo, _mod, _ser, _nota)
+                if not _relatorio_lista_ja_tem_chave(rel_list, _itpc["Chave"]) and not _registro_manual_cancel_duplicada(
+                    rel_list, _mod, _ser, _nota
+                ):
+                    _relatorio_anexar(rel_list, _itpc)
+                    out["canc"] += 1
+            if out["canc"] == 0 and trc:
+                out["msgs"].append(
+                    "**Canceladas:** nenhuma linha coincidiu com buraco (ou já existia no relatório)."
+                )
+            if _ign_c > 0:
+                out["msgs"].append(f"**Canceladas:** {_ign_c} linha(s) ignoradas (não eram buraco).")
+
+    return out
+
+
+def _norm_cab_inutil_col(c):
+    s = unicodedata.normalize("NFD", str(c).strip().lower())
+    s = "".join(ch for ch in s if unicodedata.category(ch) != "Mn")
+    return s.replace(" ", "_")
+
+
+def triplas_inutil_de_dataframe(df):
+    """
+    CabeÃ§alhos flexÃ­veis â†’ lista (modelo, série, nota).
+    Modelo: modelo, documento, tipo, doc… | Série: série, serie, ser… | Nota: nota, número, num, num_faltante…
+    """
+    if df is None or df.empty:
+        return None, "A planilha está vazia."
+    df = df.dropna(how="all")
+    if df.empty:
+        return None, "A planilha está vazia."
+    ren = {c: _norm_cab_inutil_col(c) for c in df.columns}
+    d2 = df.rename(columns=ren)
+
+    def col(*aliases):
+        for a in aliases:
+            if a in d2.columns:
+                return a
+        return None
+
+    cm = col("modelo", "documento", "tipo", "doc", "document", "mod", "cod_mod", "codigo")
+    cs = col("serie", "ser")
+    cn = col("nota", "numero", "num", "num_faltante", "n", "numeracao", "no")
+    if not cm or not cs or not cn:
+        return (
+            None,
+            "Faltam colunas reconhecíveis. Use **Modelo** (código Sefaz **55**, **65**, **57**, **67**, **58** ou NF-e…), "
+            "**Série** e **Nota** (ou Número / Num_Faltante).",
+        )
+    out = []
+    for _, row in d2.iterrows():
+        m = row.get(cm)
+        s = row.get(cs)
+        nraw = row.get(cn)
+        if (m is None or pd.isna(m)) and (s is None or pd.isna(s)) and (nraw is None or pd.isna(nraw)):
+            continue
+        if m is None or pd.isna(m) or s is None or pd.isna(s) or nraw is None or pd.isna(nraw):
+            continue
+        mod = _normaliza_modelo_filtro(m)
+        ser = _normaliza_serie_filtro(s)
+        if not mod or not ser:
+            continue
+        if isinstance(nraw, (int, float)) and not pd.isna(nraw):
+            try:
+                n = int(float(nraw))
+            except (TypeError, ValueError):
+                continue
+        else:
+            d = "".join(filter(str.isdigit, str(nraw)))
+            if not d:
+                continue
+            try:
+                n = int(d)
+            except ValueError:
+                continue
+        if n <= 0:
+            continue
+        out.append((mod, ser, n))
+    if not out:
+        return None, "Nenhuma linha válida (modelo, série e nota preenchidos)."
+    return out, None
+
+
+def dataframe_de_upload_inutil(uploaded_file, max_linhas=50000):
+    """Lê CSV ou Excel enviado pelo utilizador."""
+    if uploaded_file is None:
+        return None, None
+    nome = (getattr(uploaded_file, "name", None) or "").lower()
+    raw = uploaded_file.read()
+    try:
+        uploaded_file.seek(0)
+    except Exception:
+        pass
+    if nome.endswith(".csv"):
+        for enc in ("utf-8-sig", "utf-8", "cp1252", "latin-1"):
+            try:
+                df = pd.read_csv(io.BytesIO(raw), sep=None, engine="python", encoding=enc)
+                break
+            except Exception:
+                df = None
+        if df is None:
+            return None, "Não foi possível ler o CSV (tente UTF-8 ou separador `;` / `,`)."
+    elif nome.endswith((".xlsx", ".xls")):
+        try:
+            df = pd.read_excel(io.BytesIO(raw))
+        except Exception as e:
+            return None, f"Erro ao ler Excel: {e}"
+    else:
+        return None, "Use ficheiro **.csv**, **.xlsx** ou **.xls**."
+    df = _df_inutil_expandir_layout_sefaz_se_aplicavel(df)
+    if len(df) > max_linhas:
+        return None, f"No máximo {max_linhas} linhas por ficheiro."
+    return df, None
+
+
+def _try_expand_sefaz_inutil_num_inicial_final(df: pd.DataFrame):
+    """
+    Exportação típica da Sefaz (inutilizadas): colunas como Ano, Modelo, Série,
+    Número Inicial, Número Final, Protocolo, …
+    Devolve DataFrame com colunas Modelo, Série, Nota (uma linha por nota no intervalo)
+    ou None se o cabeçalho não for este formato.
+    """
+    if df is None or df.empty:
+        return None
+    ren = {c: _norm_cab_inutil_col(c) for c in df.columns}
+    d2 = df.rename(columns=ren)
+    obr = ("modelo", "serie", "numero_inicial", "numero_final")
+    if not all(k in d2.columns for k in obr):
+        return None
+    rows = []
+    lim_faixa = 5000  # alinhado a _MAX_FAIXA_EXPORT_DOM / faixa inutil na UI
+    for _, row in d2.iterrows():
+        if row.isna().all():
+            continue
+        m = row.get("modelo")
+        s = row.get("serie")
+        n0r = row.get("numero_inicial")
+        n1r = row.get("numero_final")
+        try:
+            n0 = int(float(n0r))
+            n1 = int(float(n1r))
+        except (TypeError, ValueError):
+            continue
+        if n0 <= 0 or n1 <= 0:
+            continue
+        if n0 > n1:
+            n0, n1 = n1, n0
+        if (n1 - n0 + 1) > lim_faixa:
+            n1 = n0 + lim_faixa - 1
+        mod = _normaliza_modelo_filtro(m)
+        ser = _normaliza_serie_filtro(s)
+        if not mod or not ser:
+            continue
+        for n in range(n0, n1 + 1):
+            rows.append({"Modelo": mod, "Série": ser, "Nota": int(n)})
+    if not rows:
+        return None
+    return pd.DataFrame(rows)
+
+
+def _df_inutil_expandir_layout_sefaz_se_aplicavel(df: pd.DataFrame):
+    """Após ler Excel/CSV ou texto: se for grelha Sefaz inutil., expande para Modelo/Série/Nota."""
+    if df is None or df.empty:
+        return df
+    exp = _try_expand_sefaz_inutil_num_inicial_final(df)
+    if exp is not None and not exp.empty:
+        return exp
+    return df
+
+
+def dataframe_de_texto_colar_planilha(texto: str, max_linhas: int = 50000):
+    """
+    Interpreta texto colado a partir do site da Sefaz ou do Excel (separador tab, ; ou ,).
+    A primeira linha não vazia deve ser o cabeçalho com colunas reconhecíveis por triplas_inutil_de_dataframe.
+    """
+    t = (texto or "").strip()
+    if not t:
+        return None, None
+    linhas = [ln for ln in t.splitlines() if str(ln).strip()]
+    if not linhas:
+        return None, None
+    buf = "\n".join(linhas)
+    for sep in ("\t", ";", ","):
+        try:
+            df = pd.read_csv(io.StringIO(buf), sep=sep, engine="python")
+            if df is not None and not df.empty and len(df.columns) >= 2:
+                df = _df_inutil_expandir_layout_sefaz_se_aplicavel(df)
+                if len(df) > max_linhas:
+                    return None, f"No máximo {max_linhas} linhas."
+                return df, None
+        except Exception:
+            continue
+    try:
+        df = pd.read_csv(io.StringIO(buf), sep=r"\s+", engine="python")
+        if df is not None and not df.empty and len(df.columns) >= 3:
+            df = _df_inutil_expandir_layout_sefaz_se_aplicavel(df)
+            if len(df) > max_linhas:
+                return None, f"No máximo {max_linhas} linhas."
+            return df, None
+    except Exception:
+        pass
+    return (
+        None,
+        "Não consegui separar colunas. Cole a **tabela com cabeçalho** na 1.ª linha "
+        "(Modelo, Série, Nota **ou** Número Inicial / Número Final como na lista de inutilizadas da Sefaz). "
+        "Selecione a grelha no site, Ctrl+C; as colunas devem estar separadas por tabulação.",
+    )
+
+
+def _computar_df_divergencias_autenticidade(df_geral: pd.DataFrame, triplas_sefaz: list):
+    """
+    Compara (Modelo, Série, Nota) do relatório Sefaz com NF **autorizadas** (Status NORMAIS)
+    de **emissão própria** no relatório geral do XML.
+    """
+    if df_geral is None or df_geral.empty or not triplas_sefaz:
+        return pd.DataFrame()
+    need = {"Modelo", "Série", "Nota", "Status Final", "Origem", "Chave"}
+    if not need.issubset(set(df_geral.columns)):
+        return pd.DataFrame()
+    mp = _mask_emissao_propria_df(df_geral)
+    st_col = df_geral["Status Final"].astype(str).str.upper()
+    m_aut = mp & st_col.eq("NORMAIS")
+    v = _df_vista_chaves(df_geral)
+    pos = np.flatnonzero(
+        m_aut.to_numpy(dtype=bool)
+        & (v["modelo_norm"] != "")
+        & (v["serie"] != "")
+        & ~np.isnan(v["nota"])
+    )
+    trip = pd.DataFrame(
+        {
+            "mod": v["modelo_norm"][pos],
+            "ser": v["serie"][pos],
+            "ni": v["nota"][pos].astype("int64"),
+            "ck": _serie_por_valores_unicos(df_geral["Chave"], lambda x: str(x or "").strip())[pos],
+        }
+    )
+    xml_set = set(zip(trip["mod"], trip["ser"], trip["ni"].tolist()))
+    trip = trip.loc[trip["ck"] != ""].drop_duplicates(["mod", "ser", "ni"], keep="first")
+    chave_por_tripla = dict(zip(zip(trip["mod"], trip["ser"], trip["ni"].tolist()), trip["ck"]))
+    sefaz_set = set()
+    for mod, ser, n in triplas_sefaz:
+        try:
+            mn = _normaliza_modelo_filtro(mod)
+            sn = _normaliza_serie_filtro(ser)
+            if not mn or sn == "":
+                continue
+            sefaz_set.add((mn, sn, int(n)))
+        except (TypeError, ValueError):
+            continue
+    only_sefaz = sefaz_set - xml_set
+    only_xml = xml_set - sefaz_set
+    out_rows = []
+    for t in sorted(only_sefaz, key=lambda x: (x[0], x[1], x[2])):
+        out_rows.append(
+            {
+                "Tipo divergência": "Na Sefaz / relatório, ausente no XML do lote",
+                "Modelo": t[0],
+                "Série": t[1],
+                "Nota": t[2],
+                "Chave (XML)": "",
+            }
+        )
+    for t in sorted(only_xml, key=lambda x: (x[0], x[1], x[2])):
+        out_rows.append(
+            {
+                "Tipo divergência": "No XML do lote, ausente na Sefaz / relatório",
+                "Modelo": t[0],
+                "Série": t[1],
+                "Nota": t[2],
+                "Chave (XML)": chave_por_tripla.get(t, ""),
+            }
+        )
+    return pd.DataFrame(out_rows)
+
+
+def _tem_upload_autenticidade(up) -> bool:
+    """True se hÃ¡ pelo menos um ficheiro no uploader (lista vazia ou None â†’ False)."""
+    if up is None:
+        return False
+    if isinstance(up, (list, tuple)):
+        return len(up) > 0
+    return True
+
+
+def _aplicar_comparacao_autenticidade(upload_files) -> tuple:
+    """Lê uma ou várias planilhas Sefaz, agrega linhas e cruza com df_geral. Devolve (ok, mensagem)."""
+    st.session_state.pop("df_divergencias", None)
+    st.session_state["validation_done"] = False
+    if upload_files is None:
+        return True, ""
+    files = list(upload_files) if isinstance(upload_files, (list, tuple)) else [upload_files]
+    files = [f for f in files if f is not None]
+    if not files:
+        return True, ""
+    dfs_valid = []
+    for f in files:
+        nome = getattr(f, "name", "") or "sem_nome"
+        df, err = dataframe_de_upload_inutil(f)
+        if err:
+            return False, f"**Autenticidade** (`{nome}`): {err}"
+        if df is not None and not df.empty:
+            dfs_valid.append(df)
+    if not dfs_valid:
+        return False, "**Autenticidade:** nenhum ficheiro tinha linhas de dados (planilhas vazias?)."
+    merged = pd.concat(dfs_valid, ignore_index=True) if len(dfs_valid) > 1 else dfs_valid[0]
+    triplas, err2 = triplas_inutil_de_dataframe(merged)
+    if err2:
+        return False, f"**Autenticidade** ({len(files)} ficheiro(s) combinados): {err2}"
+    df_g = st.session_state.get("df_geral")
+    if df_g is None or (isinstance(df_g, pd.DataFrame) and df_g.empty):
+        return False, "**Autenticidade:** relatório geral vazio — faça o garimpo primeiro."
+    df_div = _computar_df_divergencias_autenticidade(df_g, triplas)
+    if df_div is not None and not df_div.empty:
+        st.session_state["df_divergencias"] = df_div
+    else:
+        st.session_state.pop("df_divergencias", None)
+    st.session_state["validation_done"] = True
+    n_lin = len(triplas)
+    n_div = len(df_div) if df_div is not None else 0
+    n_f = len(files)
+    suf = f"{n_f} ficheiro(s), " if n_f > 1 else ""
+    return (
+        True,
+        f"**Autenticidade:** {suf}**{n_lin}** linha(s) na planilha Sefaz (agregadas); **{n_div}** divergência(s) "
+        f"(autorizadas próprias NORMAIS no XML vs relatório).",
+    )
+
+
+def conjunto_triplas_buracos(df_faltantes):
+    """{(Tipo, série_str, Num_Faltante)} a partir da tabela de buracos do garimpeiro."""
+    if df_faltantes is None or df_faltantes.empty:
+        return set()
+    d = df_faltantes.copy()
+    if "Serie" in d.columns and "Série" not in d.columns:
+        d = d.rename(columns={"Serie": "Série"})
+    if not {"Tipo", "Série", "Num_Faltante"}.issubset(d.columns):
+        return set()
+
+    def _int_ou_none(n):
+        try:
+            return int(n)
+        except (TypeError, ValueError):
+            return None
+
+    nf = d["Num_Faltante"]
+    if pd.api.types.is_numeric_dtype(nf):
+        nums = np.trunc(nf.to_numpy(dtype="float64", na_value=np.nan))
+    else:
+        nums = _serie_por_valores_unicos(nf, _int_ou_none).astype("float64")
+    ok = ~np.isnan(nums)
+    tipos = _serie_por_valores_unicos(d["Tipo"], lambda x: str(x).strip())[ok]
+    series = _serie_por_valores_unicos(d["Série"], lambda x: str(x).strip())[ok]
+    return set(zip(tipos, series, nums[ok].astype("int64").tolist()))
+
+
+def _dataframe_modelo_planilha_inutil_sem_xml():
+    """Linhas de exemplo com código numérico Sefaz (como na página da Sefaz) — também aceita NF-e, NFC-e…"""
+    return pd.DataFrame(
+        [
+            {"Modelo": 55, "Série": 1, "Nota": 1520},
+            {"Modelo": 55, "Série": 1, "Nota": 1521},
+            {"Modelo": 65, "Série": 2, "Nota": 100},
+            {"Modelo": 57, "Série": 1, "Nota": 500},
+            {"Modelo": 67, "Série": 1, "Nota": 10},
+        ]
+    )
+
+
+def _bytes_modelo_planilha_exemplo_xlsx(sheet_name: str):
+    """
+    Gera bytes do .xlsx modelo (exemplo Modelo/Série/Nota).
+    Se xlsxwriter falhar por disco/temp cheio, tenta openpyxl; em falha total devolve None.
+    """
+    df = _dataframe_modelo_planilha_inutil_sem_xml()
+    try:
+        buf = io.BytesIO()
+        with pd.ExcelWriter(buf, engine="xlsxwriter") as writer:
+            df.to_excel(writer, sheet_name=sheet_name, index=False)
+            ws = writer.sheets[sheet_name]
+            ws.set_column(0, 0, 14)
+            ws.set_column(1, 1, 10)
+            ws.set_column(2, 2, 12)
+        return buf.getvalue()
+    except Exception as exc:
+        if not _erro_sem_espaco_disco(exc):
+            raise
+    try:
+        buf2 = io.BytesIO()
+        with pd.ExcelWriter(buf2, engine="openpyxl") as writer:
+            df.to_excel(writer, sheet_name=sheet_name, index=False)
+        return buf2.getvalue()
+    except Exception:
+        return None
+
+
+def bytes_modelo_planilha_inutil_sem_xml_xlsx():
+    """Bytes do modelo ou None se não houver espaço para gerar o .xlsx."""
+    return _bytes_modelo_planilha_exemplo_xlsx("Inutil_sem_XML")
+
+
+def bytes_modelo_planilha_cancel_sem_xml_xlsx():
+    """Mesmo layout que inutilizadas (Modelo, Série, Nota) — só canceladas declaradas manualmente."""
+    return _bytes_modelo_planilha_exemplo_xlsx("Cancel_sem_XML")
+
+
+def _dataframe_modelo_lista_especifica_ini_fim_serie():
+    """
+    Modelo para Â«Lista especÃ­ficaÂ» â†’ Excel (nº e série).
+    Uma faixa por linha; cabeçalhos reconhecidos por extrair_faixas_ini_fim_serie_excel.
+    """
+    return pd.DataFrame(
+        [
+            {"Inicial": 1, "Final": 100, "Série": 1},
+            {"Inicial": 500, "Final": 502, "Série": 1},
+        ]
+    )
+
+
+def bytes_modelo_lista_especifica_ini_fim_serie_xlsx():
+    """Bytes do .xlsx modelo (Inicial, Final, Série) ou None se não houver espaço para gerar."""
+    df = _dataframe_modelo_lista_especifica_ini_fim_serie()
+    _sn = "Faixas_notas"
+    try:
+        buf = io.BytesIO()
+        with pd.ExcelWriter(buf, engine="xlsxwriter") as writer:
+            df.to_excel(writer, sheet_name=_sn, index=False)
+            ws = writer.sheets[_sn]
+            ws.set_column(0, 0, 12)
+            ws.set_column(1, 1, 12)
+            ws.set_column(2, 2, 14)
+        return buf.getvalue()
+    except Exception as exc:
+        if not _erro_sem_espaco_disco(exc):
+            raise
+    try:
+        buf2 = io.BytesIO()
+        with pd.ExcelWriter(buf2, engine="openpyxl") as writer:
+            df.to_excel(writer, sheet_name=_sn, index=False)
+        return buf2.getvalue()
+    except Exception:
+        return None
+
+
+def _dataframe_modelo_lista_especifica_chaves():
+    """Uma coluna Chave com exemplo (substitua pelas chaves de 44 dígitos)."""
+    return pd.DataFrame(
+        {
+            "Chave": [
+                "35250000000000000000000000000000000000000000",
+                "35250000000000000000000000000000000000000001",
+            ]
+        }
+    )
+
+
+def bytes_modelo_lista_especifica_chaves_xlsx():
+    """Modelo Excel só com coluna Chave (lista específica)."""
+    df = _dataframe_modelo_lista_especifica_chaves()
+    _sn = "Chaves"
+    try:
+        buf = io.BytesIO()
+        with pd.ExcelWriter(buf, engine="xlsxwriter") as writer:
+            df.to_excel(writer, sheet_name=_sn, index=False)
+            ws = writer.sheets[_sn]
+            ws.set_column(0, 0, 50)
+        return buf.getvalue()
+    except Exception as exc:
+        if not _erro_sem_espaco_disco(exc):
+            raise
+    try:
+        buf2 = io.BytesIO()
+        with pd.ExcelWriter(buf2, engine="openpyxl") as writer:
+            df.to_excel(writer, sheet_name=_sn, index=False)
+        return buf2.getvalue()
+    except Exception:
+        return None
+
+
+def _item_inutil_manual_sem_xml(res):
+    """Inutilização «sem XML» inserida pelo utilizador (não vem de ficheiro)."""
+    return (
+        res.get("Status") == "INUTILIZADOS"
+        and _inutil_sem_xml_manual(res)
+        and "EMITIDOS_CLIENTE" in res.get("Pasta", "")
+    )
+
+
+def _relatorio_vencedores(rel):
+    """
+    Linhas do relatório (índices de `_relatorio_linha`) que ficam depois da deduplicação por Chave — a 1.ª
+    ocorrência, ou a última com estado que a substitui —, pela ordem da 1.ª ocorrência da Chave.
+    """
+    lote = {}
+    if _relatorio_e_colunar(rel):
+        literais = rel["literais"]
+        c_st = rel["codigos"]["Status"]
+        substitui = [s in _RELATORIO_STATUS_SUBSTITUI for s in rel["valores"]["Status"]]
+        for i, key in enumerate(rel["texto"]["Chave"]):
+            if key in lote:
+                c = c_st[i]
+                if substitui[c] if c >= 0 else literais[i]["Status"] in _RELATORIO_STATUS_SUBSTITUI:
+                    lote[key] = i
+            else:
+                lote[key] = i
+        extra = enumerate(rel["manuais"], rel["n"])
+    else:
+        extra = enumerate(rel or [])
+    for i, item in extra:
+        key = item["Chave"]
+        if key in lote:
+            if item["Status"] in _RELATORIO_STATUS_SUBSTITUI:
+                lote[key] = i
+        else:
+            lote[key] = i
+    return list(lote.values())
+
+
+def _relatorio_iter_vencedores(rel, vencedores):
+    """
+    Por vencedor: (linha, Tipo, Série, Número, Status, Ano, Mes, CNPJ_Emit, Valor, Range, is_p, item) lidos
+    das colunas; `item` é o dict quando o registo está guardado assim (manuais…), senão None.
+    """
+    n = rel["n"]
+    literais, faixas = rel["literais"], rel["faixas"]
+    cod, val = rel["codigos"], rel["valores"]
+    c_tipo, c_serie, c_st, c_ano, c_mes, c_cnpj, c_pasta = (
+        cod[c] for c in ("Tipo", "Série", "Status", "Ano", "Mes", "CNPJ_Emit", "Pasta")
+    )
+    v_tipo, v_serie, v_st, v_ano, v_mes, v_cnpj = (
+        val[c] for c in ("Tipo", "Série", "Status", "Ano", "Mes", "CNPJ_Emit")
+    )
+    proprio = ["EMITIDOS_CLIENTE" in p for p in val["Pasta"]]
+    numero, valor = rel["numero"], rel["valor"]
+    for i in vencedores:
+        if i >= n or i in literais:
+            res = _relatorio_linha(rel, i)
+            yield (
+                i,
+                res["Tipo"],
+                res["Série"],
+                res["Número"],
+                res["Status"],
+                res["Ano"],
+                res["Mes"],
+                res.get("CNPJ_Emit", ""),
+                res["Valor"],
+                res.get("Range"),
+                "EMITIDOS_CLIENTE" in res["Pasta"],
+                res,
+            )
+            continue
+        yield (
+            i,
+            v_tipo[c_tipo[i]],
+            v_serie[c_serie[i]],
+            numero[i],
+            v_st[c_st[i]],
+            v_ano[c_ano[i]],
+            v_mes[c_mes[i]],
+            v_cnpj[c_cnpj[i]],
+            valor[i],
+            faixas.get(i),
+            proprio[c_pasta[i]],
+            None,
+        )
+
+
+def _lote_recalc_de_relatorio(relatorio):
+    """Mesma deduplicação por Chave que reconstruir_dataframes_relatorio_simples: {Chave: (item, is_p)}."""
+    lote = {}
+    for i in _relatorio_vencedores(relatorio):
+        item = _relatorio_linha(relatorio, i)
+        lote[item["Chave"]] = (item, "EMITIDOS_CLIENTE" in item["Pasta"])
+    return lote
+
+
+def _conjunto_buracos_sem_inutil_manual(rel, vencedores, ref_ar, ref_mr, ref_map):
+    """
+    Buracos atuais ignorando inutilizações manuais «sem XML», em faixas: {(Tipo, série_str): faixas (k, 2)}
+    para cruzar com o que o utilizador declara (`_buraco_h_contem`). As inutilizações entram como faixas.
+    Mantém todos os modelos em emissão própria (H) para não apagar inutil. manual de NFC-e/CT-e por engano.
+    """
+    audit_map = {}
+    ult_cache = {}
+    for _i, tipo, serie, numero, status, ano, mes, _cnpj, _valor, rng, is_p, res in _relatorio_iter_vencedores(
+        rel, vencedores
+    ):
+        if not is_p:
+            continue
+        if res is not None and _item_inutil_manual_sem_xml(res):
+            continue
+        sk = (tipo, serie)
+        dados = audit_map.get(sk)
+        if dados is None:
+            dados = audit_map[sk] = {"nums": set(), "nums_buraco": set(), "faixas": [], "faixas_buraco": []}
+            ult_cache[sk] = ultimo_ref_lookup(ref_map, tipo, serie)
+        ult_u = ult_cache[sk]
+        if status == "INUTILIZADOS":
+            ra, rb = rng if rng is not None else (numero, numero)
+            dados["faixas"].append((ra, rb))
+            faixa_b = _buraco_faixa_inut(ano, mes, ra, rb, ref_ar, ref_mr, ult_u)
+            if faixa_b is not None:
+                dados["faixas_buraco"].append(faixa_b)
+        elif numero > 0:
+            dados["nums"].add(numero)
+            if incluir_numero_no_conjunto_buraco(ano, mes, numero, ref_ar, ref_mr, ult_u):
+                dados["nums_buraco"].add(numero)
+
+    H = {}
+    for (t, s), dados in audit_map.items():
+        ult_lookup = ultimo_ref_lookup(ref_map, t, s) if ref_ar is not None else None
+        faixas = faixas_buraco_por_serie(
+            dados["nums_buraco"],
+            ult_lookup,
+            nums_existentes=dados["nums"],
+            faixas_buraco=dados["faixas_buraco"],
+            faixas_existentes=dados["faixas"],
+        )
+        if len(faixas):
+            chave = (t, str(s).strip())
+            H[chave] = _buraco_faixas_unir(H[chave], faixas) if chave in H else faixas
+    return H
+
+
+def _buraco_h_contem(H, tipo, serie_str, n) -> bool:
+    """(tipo, série, n) é buraco em H ({(Tipo, série_str): faixas}, ver `_conjunto_buracos_sem_inutil_manual`)?"""
+    return _buraco_faixas_intersecta(H.get((tipo, serie_str)), n, n)
+
+
+# --- RECONSTRUÇÃO INCREMENTAL DAS TABELAS ---
+# Depois de cada reconstrução completa guarda-se, por (Tipo, Série) do resumo, os números dos documentos do lote
+# (`nums`, `nums_buraco`, `valor`) e, à parte, o contributo de cada registo manual (inutil. / cancel. sem XML).
+# Se o relatório só mudou na cauda de registos manuais (inclusão por buraco / planilha / faixa, «Desfazer»,
+# ou releitura do lote sem ficheiros novos), só as séries tocadas são recalculadas e as tabelas levam
+# apenas as linhas novas / perdem as removidas — o resultado é o mesmo da reconstrução completa.
+SESSION_KEY_RELATORIO_INCREMENTAL = "_relatorio_incremental"
+_RELATORIO_DFS_LINHAS = (
+    "df_geral",
+    "df_canceladas",
+    "df_inutilizadas",
+    "df_autorizadas",
+    "df_denegadas",
+    "df_rejeitadas",
+)
+
+
+def _relatorio_linhas_item(res, is_p, H, cnpj_cli, ref_ar, ref_mr, ref_map):
+    """
+    Contributo de um documento do lote (já deduplicado por Chave) para as tabelas:
+    (linhas_geral, linhas_inut, df_lista, registo, sk, nums, nums_buraco, valor) — `df_lista` é a tabela por
+    estado que recebe `registo` (ou None); `sk` = (Tipo, Série) do resumo, None se não entra nele.
+    """
+    if is_p:
+        origem_label = f"EMISSÃO PRÓPRIA ({res['Operacao']})"
+    else:
+        origem_label = f"TERCEIROS ({res['Operacao']})"
+
+    registro_detalhado = {
+        "Origem": origem_label,
+        "Operação": res["Operacao"],
+        "Modelo": res["Tipo"],
+        "Série": res["Série"],
+        "Nota": res["Número"],
+        "Data Emissão": res["Data_Emissao"],
+        "CNPJ Emitente": res["CNPJ_Emit"],
+        "Nome Emitente": res["Nome_Emit"],
+        "Doc Destinatário": res["Doc_Dest"],
+        "Nome Destinatário": res["Nome_Dest"],
+        "UF Destino": res.get("UF_Dest") or "",
+        "Chave": res["Chave"],
+        "Status Final": res["Status"],
+        "Valor": res["Valor"],
+        "Ano": res["Ano"],
+        "Mes": res["Mes"],
+    }
+    geral = []
+    inut = []
+    nums = []
+    nums_buraco = []
+    df_lista = None
+    valor = 0.0
+
+    if res["Status"] == "INUTILIZADOS":
+        r = res.get("Range", (res["Número"], res["Número"]))
+        ra, rb = int(r[0]), int(r[1])
+        _man_inut = _inutil_sem_xml_manual(res)
+        _resumo = _incluir_em_resumo_por_serie(res, is_p, cnpj_cli)
+        ult_u = ultimo_ref_lookup(ref_map, res["Tipo"], res["Série"]) if _resumo else None
+        for n in range(ra, rb + 1):
+            if _man_inut:
+                if not _buraco_h_contem(H, res["Tipo"], str(res["Série"]).strip(), n):
+                    continue
+            item_inut = registro_detalhado.copy()
+            item_inut.update({"Nota": n, "Status Final": "INUTILIZADA", "Valor": 0.0})
+            geral.append(item_inut)
+            if is_p:
+                inut.append({"Modelo": res["Tipo"], "Série": res["Série"], "Nota": n})
+            if _resumo:
+                nums.append(n)
+                if _man_inut:
+                    nums_buraco.append(n)
+                elif incluir_numero_no_conjunto_buraco(res["Ano"], res["Mes"], n, ref_ar, ref_mr, ult_u):
+                    nums_buraco.append(n)
+    else:
+        geral.append(registro_detalhado)
+        if is_p:
+            if res["Status"] == "DENEGADOS":
+                df_lista = "df_denegadas"
+            elif res["Status"] == "REJEITADOS":
+                df_lista = "df_rejeitadas"
+            elif res["Número"] > 0:
+                if res["Status"] == "CANCELADOS":
+                    df_lista = "df_canceladas"
+                elif res["Status"] == "NORMAIS":
+                    df_lista = "df_autorizadas"
+        if _incluir_em_resumo_por_serie(res, is_p, cnpj_cli) and res["Número"] > 0:
+            ult_u = ultimo_ref_lookup(ref_map, res["Tipo"], res["Série"])
+            nums.append(res["Número"])
+            if _cancel_sem_xml_manual(res):
+                nums_buraco.append(res["Número"])
+            elif incluir_numero_no_conjunto_buraco(
+                res["Ano"],
+                res["Mes"],
+                res["Número"],
+                ref_ar,
+                ref_mr,
+                ult_u,
+            ):
+                nums_buraco.append(res["Número"])
+            valor = res["Valor"]
+
+    sk = (res["Tipo"], res["Série"]) if nums else None
+    return geral, inut, df_lista, registro_detalhado, sk, nums, nums_buraco, valor
+
+
+def _relatorio_serie_obter(series, sk, pos):
+    """Acumulador da série `sk` (números soltos, faixas de inutilização, valor); `pos` = 1.º documento do lote."""
+    ser = series.get(sk)
+    if ser is None:
+        ser = series[sk] = {
+            "nums": set(),
+            "nums_buraco": set(),
+            "faixas": [],
+            "faixas_buraco": [],
+            "valor": 0.0,
+            "pos": pos,
+        }
+    elif ser["pos"] is None:
+        ser["pos"] = pos
+    return ser
+
+
+def _relatorio_linhas_serie(sk, nums, nums_buraco, valor, ref_ar, ref_map, faixas=(), faixas_buraco=()):
+    """
+    (linha do resumo por série, faixas de buracos — ver `faixas_buraco_por_serie`) de uma série.
+    `faixas` / `faixas_buraco`: inutilizações do lote, em (início, fim), além dos números soltos.
+    """
+    t, s = sk
+    linha_resumo = None
+    cobertos = _buraco_faixas_conjunto(nums, faixas)
+    if len(cobertos):
+        linha_resumo = {
+            "Documento": t,
+            "Série": s,
+            "Início": int(cobertos[0, 0]),
+            "Fim": int(cobertos[-1, 1]),
+            "Quantidade": _buraco_faixas_tamanho(cobertos),
+            "Valor Contábil (R$)": round(valor, 2),
+        }
+    ult_lookup = ultimo_ref_lookup(ref_map, t, s) if ref_ar is not None else None
+    return linha_resumo, faixas_buraco_por_serie(
+        nums_buraco,
+        ult_lookup,
+        faixas_buraco=faixas_buraco,
+        faixas_existentes=cobertos,
+    )
+
+
+def _relatorio_item_manual_incremental(item) -> bool:
+    """Registo manual que a reconstrução incremental sabe incluir / retirar sozinho."""
+    ch = str(item.get("Chave") or "")
+    if ch.startswith("MANUAL_INUT_"):
+        ok = item.get("Status") == "INUTILIZADOS"
+    elif ch.startswith("MANUAL_CANC_"):
+        ok = item.get("Status") == "CANCELADOS"
+    else:
+        return False
+    try:
+        return ok and "EMITIDOS_CLIENTE" in item.get("Pasta", "") and not float(item.get("Valor") or 0)
+    except (TypeError, ValueError):
+        return False
+
+
+def _relatorio_df_tipos_base(df):
+    """Desfaz `compactar_dataframe_memoria` (categorias → object, inteiros/reais → 64 bits) antes de juntar linhas."""
+    out = df.copy()
+    for col in out.columns:
+        dt = out[col].dtype
+        if isinstance(dt, pd.CategoricalDtype):
+            out[col] = out[col].astype(object)
+        elif pd.api.types.is_bool_dtype(dt):
+            continue
+        elif pd.api.types.is_integer_dtype(dt):
+            out[col] = out[col].astype("int64")
+        elif pd.api.types.is_float_dtype(dt):
+            out[col] = out[col].astype("float64")
+    return out
+
+
+def _relatorio_df_remendar(df, remover_mask, novas_linhas):
+    """Tira as linhas marcadas e junta as novas no fim, com os tipos de `pd.DataFrame(lista)`."""
+    if remover_mask is None and not novas_linhas:
+        return df
+    if df is None or df.empty:
+        return pd.DataFrame(novas_linhas)
+    base = df[~remover_mask] if remover_mask is not None else df
+    base = _relatorio_df_tipos_base(base)
+    if novas_linhas:
+        base = pd.concat([base, pd.DataFrame(novas_linhas)], ignore_index=True)
+    else:
+        base = base.reset_index(drop=True)
+    if base.empty:
+        return pd.DataFrame([])
+    return base
+
+
+def _relatorio_incremental_aplicar(rel, ref_ar, ref_mr, ref_map, cnpj_cli) -> bool:
+    """
+    Tenta atualizar as tabelas só com a diferença para a última reconstrução. False = não é possível
+    (lote, referência de buracos ou CNPJ mudaram, registos fora da cauda manual…) — faça a completa.
+    """
+    est = _session_state_get_garimpo(SESSION_KEY_RELATORIO_INCREMENTAL)
+    if not est or est["ctx"] != (ref_ar, ref_mr, dict(ref_map or {}), cnpj_cli):
+        return False
+    for nome, n in est["n_linhas"].items():
+        df = st.session_state.get(nome)
+        if (len(df) if isinstance(df, pd.DataFrame) else -1) != n:
+            return False
+
+    # Os documentos em colunas têm de ser os mesmos; a diferença fica na cauda `manuais`.
+    if est["docs"] != _relatorio_assinatura_docs(rel):
+        return False
+    prev, cur = est["manuais"], rel["manuais"]
+    i, n_min = 0, min(len(prev), len(cur))
+    while i < n_min and (prev[i] is cur[i] or prev[i] == cur[i]):
+        i += 1
+    cauda_prev, cauda_cur = prev[i:], cur[i:]
+    if not cauda_prev and not cauda_cur:
+        # Nada mudou (ex.: releitura do lote sem ficheiros novos): as tabelas já estão certas.
+        est["manuais"] = list(cur)
+        return True
+    if not all(_relatorio_item_manual_incremental(x) for x in cauda_prev):
+        return False
+    if not all(_relatorio_item_manual_incremental(x) for x in cauda_cur):
+        return False
+    por_chave_prev = {x["Chave"]: x for x in cauda_prev}
+    por_chave_cur = {x["Chave"]: x for x in cauda_cur}
+    if len(por_chave_prev) != len(cauda_prev) or len(por_chave_cur) != len(cauda_cur):
+        return False
+    # Mantidos: mesmo conteúdo, mesma ordem e todos antes dos novos (a ordem do lote é a do relatório).
+    mantidos_prev = [x["Chave"] for x in cauda_prev if x["Chave"] in por_chave_cur]
+    n_mant = len(mantidos_prev)
+    if [x["Chave"] for x in cauda_cur[:n_mant]] != mantidos_prev:
+        return False
+    if any(por_chave_cur[k] != por_chave_prev[k] for k in mantidos_prev):
+        return False
+    removidos = [x for x in cauda_prev if x["Chave"] not in por_chave_cur]
+    novos = cauda_cur[n_mant:]
+    manual = est["manual"]
+    if any(k not in manual for k in (x["Chave"] for x in removidos)):
+        return False
+    if any(x["Chave"] in manual and x["Chave"] not in por_chave_prev for x in novos):
+        return False
+
+    H = est["H"]
+    series = est["series"]
+    tocadas = set()
+    chaves_fora = set()
+    for x in removidos:
+        k = x["Chave"]
+        _seq, sk, _n, _nb = manual.pop(k)
+        chaves_fora.add(k)
+        if sk is not None:
+            tocadas.add(sk)
+
+    novas = {nome: [] for nome in _RELATORIO_DFS_LINHAS}
+    novos_donos_inut = []
+    descartar = set()
+    for x in novos:
+        geral, inut, df_lista, reg, sk, nums, nums_buraco, _valor = _relatorio_linhas_item(
+            x, True, H, cnpj_cli, ref_ar, ref_mr, ref_map
+        )
+        if _item_inutil_manual_sem_xml(x) and not geral:
+            # Como na reconstrução completa: inutil. manual que já não cobre nenhum buraco sai do relatório.
+            descartar.add(x["Chave"])
+            continue
+        manual[x["Chave"]] = (est["seq"], sk, tuple(nums), tuple(nums_buraco))
+        est["seq"] += 1
+        novas["df_geral"].extend(geral)
+        novas["df_inutilizadas"].extend(inut)
+        novos_donos_inut.extend([x["Chave"]] * len(inut))
+        if df_lista:
+            novas[df_lista].append(reg)
+        if sk is not None:
+            tocadas.add(sk)
+            _relatorio_serie_obter(series, sk, None)
+
+    for nome in _RELATORIO_DFS_LINHAS:
+        df = st.session_state.get(nome)
+        mask = None
+        if chaves_fora and df is not None and not df.empty:
+            if nome == "df_inutilizadas":
+                if any(k in chaves_fora for k in est["inut_donos"]):
+                    mask = pd.Series([k in chaves_fora for k in est["inut_donos"]], index=df.index)
+            elif "Chave" in df.columns:
+                m = df["Chave"].isin(chaves_fora)
+                if m.any():
+                    mask = m
+        st.session_state[nome] = _relatorio_df_remendar(df, mask, novas[nome])
+    if chaves_fora:
+        est["inut_donos"] = [k for k in est["inut_donos"] if k not in chaves_fora]
+    est["inut_donos"].extend(novos_donos_inut)
+
+    for sk in tocadas:
+        ser = series[sk]
+        nums, nums_buraco = ser["nums"], ser["nums_buraco"]
+        pos = ser["pos"]
+        extra_n, extra_b = set(), set()
+        for seq, m_sk, m_n, m_nb in manual.values():
+            if m_sk == sk:
+                extra_n.update(m_n)
+                extra_b.update(m_nb)
+                pos = seq if pos is None else min(pos, seq)
+        if not nums and not ser["faixas"] and not extra_n:
+            series.pop(sk, None)
+            est["linhas_serie"].pop(sk, None)
+            continue
+        if extra_n:
+            nums = nums | extra_n
+            nums_buraco = nums_buraco | extra_b
+        est["linhas_serie"][sk] = (pos,) + _relatorio_linhas_serie(
+            sk, nums, nums_buraco, ser["valor"], ref_ar, ref_map, ser["faixas"], ser["faixas_buraco"]
+        )
+
+    ordem = sorted(est["linhas_serie"].items(), key=lambda kv: kv[1][0])
+    st.session_state["df_resumo"] = pd.DataFrame([lr for _sk, (_pos, lr, _fx) in ordem if lr is not None])
+    st.session_state["df_faltantes"] = df_faltantes_de_faixas((t, s, fx) for (t, s), (_pos, _lr, fx) in ordem)
+
+    if descartar:
+        rel = _relatorio_sem_chaves(rel, descartar)
+        st.session_state["relatorio"] = rel
+    est["manuais"] = list(rel["manuais"])
+    _relatorio_st_counts_atualizar()
+    aplicar_compactacao_dfs_sessao()
+    est["n_linhas"] = {nome: len(st.session_state[nome]) for nome in _RELATORIO_DFS_LINHAS}
+    return True
+
+
+def _relatorio_st_counts_atualizar():
+    st.session_state["st_counts"] = {
+        "CANCELADOS": len(st.session_state["df_canceladas"]),
+        "INUTILIZADOS": len(st.session_state["df_inutilizadas"]),
+        "AUTORIZADAS": len(st.session_state["df_autorizadas"]),
+        "DENEGADOS": len(st.session_state["df_denegadas"]),
+        "REJEITADOS": len(st.session_state["df_rejeitadas"]),
+    }
+
+
+def reconstruir_dataframes_relatorio_simples():
+    """
+    Recalcula tabelas a partir de st.session_state['relatorio'] (status no próprio item).
+    Quando só mudaram registos manuais no fim do relatório, atualiza apenas as séries tocadas
+    (ver `_relatorio_incremental_aplicar`).
+    """
+    rel = st.session_state["relatorio"]
+    if not _relatorio_e_colunar(rel):
+        rel = _relatorio_colunar_de_lista(rel)
+        st.session_state["relatorio"] = rel
+    ref_ar, ref_mr, ref_map = buraco_ctx_sessao()
+    _cnpj_cli = "".join(c for c in str(st.session_state.get("cnpj_widget", "")) if c.isdigit())[:14]
+
+    try:
+        feito = _relatorio_incremental_aplicar(rel, ref_ar, ref_mr, ref_map, _cnpj_cli)
+    except Exception:
+        feito = False
+    if not feito:
+        _relatorio_reconstruir_completo(rel, ref_ar, ref_mr, ref_map, _cnpj_cli)
+    try:
+        st.session_state.pop("_v2_cascade_cache_v1", None)
+    except Exception:
+        pass
+    _garimpo_registar_aviso_sped_chaves_sem_xml_no_lote(
+        st.session_state.get("df_geral"),
+        _sped_fonte_sessao(),
+    )
+
+
+def _relatorio_objetos(valores):
+    """Array NumPy de objetos (partilha as strings da lista, sem as copiar)."""
+    a = np.empty(max(len(valores), 1), dtype=object)
+    a[: len(valores)] = valores
+    if not valores:
+        a[0] = ""
+    return a
+
+
+def _relatorio_dfs_de_vencedores(rel, vencedores, esp_linhas):
+    """
+    df_geral, tabelas por estado e df_inutilizadas dos vencedores, montadas coluna a coluna a partir do
+    relatório em colunas (o mesmo que juntar as linhas de `_relatorio_linhas_item` de cada um).
+    `esp_linhas`: {linha: (geral, inut, df_lista, registo, is_p)} dos registos guardados como dict.
+    Devolve ({nome da tabela: DataFrame}, donos de df_inutilizadas).
+    """
+    n = rel["n"]
+    cod, val, texto = rel["codigos"], rel["valores"], rel["texto"]
+    v = np.asarray(vencedores, dtype=np.int64)
+    esp = np.fromiter((i in esp_linhas for i in vencedores), dtype=bool, count=len(vencedores))
+    src = np.where(esp, 0, v)
+
+    def _codigos(c):
+        if not n:
+            return np.zeros(len(v), dtype=np.int64)
+        return _relatorio_np(cod[c]).astype(np.int64)[src]
+
+    def _numerico(arr):
+        if not n:
+            return np.zeros(len(v), dtype=_RELATORIO_NP_TIPOS[arr.typecode])
+        return _relatorio_np(arr)[src]
+
+    c_status = _codigos("Status")
+    inut_w = ~esp & np.array([s == "INUTILIZADOS" for s in val["Status"]] or [False])[c_status]
+    p_w = np.array(["EMITIDOS_CLIENTE" in p for p in val["Pasta"]] or [False])[_codigos("Pasta")]
+    numero_w = _numerico(rel["numero"])
+    ra_w = numero_w.copy()
+    rb_w = numero_w.copy()
+    for k in np.flatnonzero(inut_w).tolist():
+        faixa = rel["faixas"].get(int(v[k]))
+        if faixa is not None:
+            ra_w[k], rb_w[k] = faixa
+    cnt = np.where(inut_w, np.maximum(rb_w - ra_w + 1, 0), 1)
+    k_esp = np.flatnonzero(esp).tolist()
+    esp_inut_w = np.zeros(len(v), dtype=bool)
+    for k in k_esp:
+        geral, inut, _df_lista, _reg, is_p = esp_linhas[int(v[k])]
+        cnt[k] = len(geral)
+        p_w[k] = is_p
+        esp_inut_w[k] = bool(inut)
+
+    vazio = {nome: pd.DataFrame([]) for nome in _RELATORIO_DFS_LINHAS}
+    tot = int(cnt.sum())
+    if not tot:
+        return vazio, []
+    w_row = np.repeat(np.arange(len(v)), cnt)
+    inicio = np.cumsum(cnt) - cnt
+    src_row = src[w_row]
+    esp_row = esp[w_row]
+    inut_row = inut_w[w_row]
+    p_row = p_w[w_row]
+    nota = np.where(inut_row, ra_w[w_row] + (np.arange(tot) - inicio[w_row]), numero_w[w_row])
+
+    def _cat(c, valores=None):
+        return _relatorio_objetos(val[c] if valores is None else valores)[_codigos(c)[w_row]]
+
+    c_op = _codigos("Operacao")[w_row]
+    origem = np.where(
+        p_row,
+        _relatorio_objetos([f"EMISSÃO PRÓPRIA ({o})" for o in val["Operacao"]])[c_op],
+        _relatorio_objetos([f"TERCEIROS ({o})" for o in val["Operacao"]])[c_op],
+    )
+    colunas = {
+        "Origem": origem,
+        "Operação": _cat("Operacao"),
+        "Modelo": _cat("Tipo"),
+        "Série": _cat("Série"),
+        "Nota": nota,
+        "Data Emissão": _cat("Data_Emissao"),
+        "CNPJ Emitente": _cat("CNPJ_Emit"),
+        "Nome Emitente": _cat("Nome_Emit"),
+        "Doc Destinatário": _cat("Doc_Dest"),
+        "Nome Destinatário": _cat("Nome_Dest"),
+        "UF Destino": _cat("UF_Dest", [u or "" for u in val["UF_Dest"]]),
+        "Chave": _relatorio_objetos(texto["Chave"])[src_row],
+        "Status Final": np.where(inut_row, "INUTILIZADA", _relatorio_objetos(val["Status"])[c_status[w_row]]),
+        "Valor": np.where(inut_row, 0.0, _numerico(rel["valor"])[w_row]),
+        "Ano": _cat("Ano"),
+        "Mes": _cat("Mes"),
+    }
+
+    # Tabela por estado de cada linha: 1 canceladas, 2 autorizadas, 3 denegadas, 4 rejeitadas.
+    _cod_lista = {"df_canceladas": 1, "df_autorizadas": 2, "df_denegadas": 3, "df_rejeitadas": 4}
+    lista_st = np.array(
+        [{"CANCELADOS": 1, "NORMAIS": 2, "DENEGADOS": 3, "REJEITADOS": 4}.get(s, 0) for s in val["Status"]]
+        or [0],
+        dtype=np.int8,
+    )
+    lista = np.where(p_row & ~inut_row & ~esp_row, lista_st[c_status[w_row]], 0)
+    lista[(lista <= 2) & (nota <= 0)] = 0
+    inut_sel = (inut_row | esp_inut_w[w_row]) & p_row
+
+    if k_esp:
+        pos = np.flatnonzero(esp_row)
+        linhas = [row for k in k_esp for row in esp_linhas[int(v[k])][0]]
+        misto = False
+        for nome in list(colunas):
+            vals = [row[nome] for row in linhas]
+            col = colunas[nome]
+            if col.dtype != object:
+                tipos_ok = (int,) if nome == "Nota" else (int, float)
+                if not all(type(x) in tipos_ok for x in vals):
+                    col = colunas[nome] = col.astype(object)
+                    misto = True
+            col[pos] = vals
+        for k in k_esp:
+            df_lista = esp_linhas[int(v[k])][2]
+            if df_lista:
+                lista[inicio[k]] = _cod_lista[df_lista]
+    else:
+        misto = False
+
+    def _df(mask=None, nomes=None):
+        cols = colunas if nomes is None else {c: colunas[c] for c in nomes}
+        if mask is not None:
+            if not mask.any():
+                return pd.DataFrame([])
+            cols = {c: a[mask] for c, a in cols.items()}
+        df = pd.DataFrame(cols)
+        return df.infer_objects() if misto else df
+
+    dfs = {"df_geral": _df(), "df_inutilizadas": _df(inut_sel, ("Modelo", "Série", "Nota"))}
+    for nome, c in _cod_lista.items():
+        dfs[nome] = _df(lista == c)
+    return dfs, colunas["Chave"][inut_sel].tolist()
+
+
+def _relatorio_reconstruir_completo(rel, ref_ar, ref_mr, ref_map, _cnpj_cli):
+    """Reconstrução a partir de todo o relatório; deixa o estado para as incrementais seguintes."""
+    _session_state_pop_garimpo(SESSION_KEY_RELATORIO_INCREMENTAL)
+    vencedores = _relatorio_vencedores(rel)
+    H = _conjunto_buracos_sem_inutil_manual(rel, vencedores, ref_ar, ref_mr, ref_map)
+
+    drop_ch = set()
+    esp = [i for i in vencedores if i >= rel["n"] or i in rel["literais"]]
+    for _i, tipo, serie, numero, _st, _a, _m, _c, _v, rng, _p, res in _relatorio_iter_vencedores(rel, esp):
+        if not _item_inutil_manual_sem_xml(res):
+            continue
+        r = rng if rng is not None else (numero, numero)
+        ra, rb = int(r[0]), int(r[1])
+        ser_s = str(serie).strip()
+        if not _buraco_faixas_intersecta(H.get((tipo, ser_s)), ra, rb):
+            drop_ch.add(res["Chave"])
+    if drop_ch:
+        rel = _relatorio_sem_chaves(rel, drop_ch)
+        st.session_state["relatorio"] = rel
+        vencedores = _relatorio_vencedores(rel)
+
+    # series: números dos documentos do lote; manual: contributo de cada registo manual (seq, sk, nums, buraco).
+    # Os documentos em colunas seguem as regras de `_relatorio_linhas_item` sem montar dicts; os registos
+    # guardados como dict passam pela própria função (linhas em `esp_linhas`).
+    series = {}
+    manual = {}
+    esp_linhas = {}
+    resumo_ok = {}
+    ult_cache = {}
+    for seq, (i, tipo, serie, numero, status, ano, mes, cnpj_emit, valor, rng, is_p, res) in enumerate(
+        _relatorio_iter_vencedores(rel, vencedores)
+    ):
+        if res is not None:
+            geral, inut, df_lista, reg, sk, nums, nums_buraco, valor = _relatorio_linhas_item(
+                res, is_p, H, _cnpj_cli, ref_ar, ref_mr, ref_map
+            )
+            esp_linhas[i] = (geral, inut, df_lista, reg, is_p)
+            if _inutil_sem_xml_manual(res) or _cancel_sem_xml_manual(res):
+                manual[res["Chave"]] = (seq, sk, tuple(nums), tuple(nums_buraco))
+                if sk is not None:
+                    _relatorio_serie_obter(series, sk, None)["valor"] += valor
+                continue
+            if sk is None:
+                continue
+        else:
+            if not is_p:
+                continue
+            ok = resumo_ok.get((tipo, cnpj_emit))
+            if ok is None:
+                ok = resumo_ok[(tipo, cnpj_emit)] = _incluir_em_resumo_por_serie(
+                    {"Tipo": tipo, "CNPJ_Emit": cnpj_emit}, True, _cnpj_cli
+                )
+            if not ok:
+                continue
+            sk = (tipo, serie)
+            if sk not in ult_cache:
+                ult_cache[sk] = ultimo_ref_lookup(ref_map, tipo, serie)
+            ult_u = ult_cache[sk]
+            if status == "INUTILIZADOS":
+                # A inutilização entra na série como faixa (nNFIni–nNFFin), sem um número de cada vez.
+                r = rng if rng is not None else (numero, numero)
+                ra, rb = int(r[0]), int(r[1])
+                if ra > rb:
+                    continue
+                ser = _relatorio_serie_obter(series, sk, seq)
+                ser["faixas"].append((ra, rb))
+                faixa_b = _buraco_faixa_inut(ano, mes, ra, rb, ref_ar, ref_mr, ult_u)
+                if faixa_b is not None:
+                    ser["faixas_buraco"].append(faixa_b)
+                continue
+            elif numero > 0:
+                nums = (numero,)
+                nums_buraco = nums if incluir_numero_no_conjunto_buraco(ano, mes, numero, ref_ar, ref_mr, ult_u) else ()
+            else:
+                continue
+        ser = _relatorio_serie_obter(series, sk, seq)
+        ser["nums"].update(nums)
+        ser["nums_buraco"].update(nums_buraco)
+        ser["valor"] += valor
+
+    manual_por_serie = defaultdict(list)
+    for seq, sk, m_n, m_nb in manual.values():
+        if sk is not None:
+            manual_por_serie[sk].append((seq, m_n, m_nb))
+
+    res_final = []
+    linhas_serie = {}
+    for sk, ser in series.items():
+        nums, nums_buraco, pos = ser["nums"], ser["nums_buraco"], ser["pos"]
+        if sk in manual_por_serie:
+            nums, nums_buraco = set(nums), set(nums_buraco)
+            for seq, m_n, m_nb in manual_por_serie[sk]:
+                nums.update(m_n)
+                nums_buraco.update(m_nb)
+                pos = seq if pos is None else min(pos, seq)
+        linha_resumo, faixas = _relatorio_linhas_serie(
+            sk, nums, nums_buraco, ser["valor"], ref_ar, ref_map, ser["faixas"], ser["faixas_buraco"]
+        )
+        linhas_serie[sk] = (pos, linha_resumo, faixas)
+        if linha_resumo is not None:
+            res_final.append(linha_resumo)
+
+    dfs, inut_donos = _relatorio_dfs_de_vencedores(rel, vencedores, esp_linhas)
+    del esp_linhas
+    st.session_state.update(
+        {
+            "df_resumo": pd.DataFrame(res_final),
+            "df_faltantes": df_faltantes_de_faixas((t, s, fx) for (t, s), (_pos, _lr, fx) in linhas_serie.items()),
+            **dfs,
+        }
+    )
+    _relatorio_st_counts_atualizar()
+    aplicar_compactacao_dfs_sessao()
+    try:
+        st.session_state[SESSION_KEY_RELATORIO_INCREMENTAL] = {
+            "ctx": (ref_ar, ref_mr, dict(ref_map or {}), _cnpj_cli),
+            "docs": _relatorio_assinatura_docs(rel),
+            "manuais": list(rel["manuais"]),
+            "H": H,
+            "series": series,
+            "manual": manual,
+            "seq": len(vencedores),
+            "linhas_serie": linhas_serie,
+            "inut_donos": inut_donos,
+            "n_linhas": {nome: len(st.session_state[nome]) for nome in _RELATORIO_DFS_LINHAS},
+        }
+    except Exception:
+        pass
+
+
+def _garim_footer_elapsed_txt(t_start):
+    """Texto legível do tempo desde o início (tempo de parede; ver `time.time()` nos chamadores)."""
+    if t_start is None:
+        return "—"
+    e = time.time() - float(t_start)
+    if e < 60:
+        return f"{e:.1f}s" if e < 12 else f"{e:.0f}s"
+    if e < 3600:
+        m = int(e // 60)
+        s = int(e % 60)
+        return f"{m}m {s:02d}s"
+    h = int(e // 3600)
+    m = int((e % 3600) // 60)
+    return f"{h}h {m:02d}m"
+
+
+_GARIM_LEITURA_OVERLAY_ID = "garimpeiro-overlay-leitura"
+
+
+def _garim_footer_overlay_remove():
+    """Remove o cartão global de progresso (anexado ao `document` da janela principal)."""
+    if _garim_trabalho_atual() is not None:
+        return
+    try:
+        import streamlit.components.v1 as components
+    except ImportError:
+        return
+    _oid = _GARIM_LEITURA_OVERLAY_ID.replace("\\", "\\\\").replace('"', '\\"')
+    components.html(
+        f"""<script>
+(function(){{
+  try {{
+    if (window._garimOvInt) {{ clearInterval(window._garimOvInt); window._garimOvInt = null; }}
+    var d = window.parent && window.parent.document;
+    if (!d) return;
+    var el = d.getElementById("{_oid}");
+    if (el) el.remove();
+  }} catch (e) {{}}
+}})();
+</script>""",
+        height=0,
+        width=0,
+    )
+
+
+def _garim_footer_overlay_paint(cur, total, arquivo, fase, t_start):
+    """
+    Cartão de estado **no topo da janela**, fixo ao viewport (acompanha o scroll), acima do layout Streamlit.
+    O tempo decorrido atualiza no **browser** (setInterval) a partir de `t_start` = `time.time()` no início da operação.
+    """
+    try:
+        import streamlit.components.v1 as components
+    except ImportError:
+        return
+    tot = max(1, int(total or 1))
+    c = min(int(cur or 0), tot)
+    pct = min(100.0, (c / float(tot)) * 100.0)
+    _an = str(arquivo or "—").replace("\\", "/")
+    _base = os.path.basename(_an) or _an
+    arq = html_escape.escape(_base)[:72]
+    fase_e = html_escape.escape(str(fase or ""))[:56]
+    elapsed0 = html_escape.escape(_garim_footer_elapsed_txt(t_start))
+    tit = html_escape.escape(f"{fase or ''} · {_base}")[:220]
+    try:
+        start_ms = int(float(t_start) * 1000) if t_start is not None else 0
+    except (TypeError, ValueError):
+        start_ms = 0
+    inner = (
+        '<div style="position:relative;z-index:1;margin:max(10px, env(safe-area-inset-top)) auto 0;'
+        "max-width:min(800px, calc(100vw - 22px));padding:0 4px;\">"
+        "<div style=\"width:100%;background:linear-gradient(180deg,#fffdfb 0%,#fff5f9 100%);"
+        "backdrop-filter:blur(14px);-webkit-backdrop-filter:blur(14px);border-radius:14px;"
+        "border:1.5px solid rgba(255,105,180,0.58);box-shadow:0 10px 32px rgba(93,27,54,0.22),0 0 0 1px rgba(255,255,255,0.88) inset;"
+        "padding:0.48rem 0.8rem 0.52rem;font-size:0.8rem;font-family:'Plus Jakarta Sans',system-ui,sans-serif;color:#3a2830;\">"
+        "<style>@keyframes garimOvDot{0%,100%{opacity:1;box-shadow:0 0 0 0 rgba(255,105,180,0.45)}50%{opacity:0.68;box-shadow:0 0 0 6px rgba(255,105,180,0)}}</style>"
+        "<div style=\"display:flex;align-items:center;flex-wrap:wrap;gap:0.4rem 0.5rem;margin-bottom:0.22rem;line-height:1.3;\">"
+        "<span style=\"display:inline-block;width:8px;height:8px;border-radius:50%;background:#ff69b4;flex-shrink:0;"
+        "animation:garimOvDot 1.45s ease-in-out infinite;\"></span>"
+        "<strong style=\"color:#5D1B36;font-size:0.86rem;\">Garimpo</strong>"
+        "</div>"
+        "<div style=\"display:flex;align-items:center;gap:0.48rem;flex-wrap:wrap;\">"
+        "<span style=\"font-variant-numeric:tabular-nums;white-space:nowrap;\">⏱ "
+        f'<span id="garimpeiro-overlay-elapsed">{elapsed0}</span></span>'
+        f"<span style=\"opacity:0.9;white-space:nowrap;\"><b>{c}</b>/<b>{tot}</b></span>"
+        f'<span style="flex:1;min-width:96px;opacity:0.88;overflow:hidden;text-overflow:ellipsis;white-space:nowrap;'
+        f'font-size:0.74rem;" title="{tit}">{fase_e} · {arq}</span>'
+        "</div>"
+        f"<div style=\"margin-top:0.38rem;height:7px;background:rgba(255,105,180,0.14);border-radius:6px;overflow:hidden;\">"
+        f"<div style=\"width:{pct:.1f}%;height:100%;background:linear-gradient(90deg,#ff9ec7,#ff69b4);border-radius:6px;\">"
+        "</div></div></div></div>"
+    )
+    b64 = base64.b64encode(inner.encode("utf-8")).decode("ascii")
+    _oid_js = _GARIM_LEITURA_OVERLAY_ID.replace("\\", "\\\\").replace('"', '\\"')
+    _sms = str(start_ms)
+    components.html(
+        f"""<script>
+(function(){{
+  try {{
+    var p = window.parent;
+    if (!p || !p.document) return;
+    var d = p.document;
+    var id = "{_oid_js}";
+    var el = d.getElementById(id);
+    if (!el) {{
+      el = d.createElement("div");
+      el.id = id;
+      el.setAttribute("role", "status");
+      el.setAttribute("aria-live", "polite");
+      el.style.cssText = "position:fixed;top:0;left:0;right:0;z-index:2147483646;pointer-events:none;";
+      d.body.appendChild(el);
+    }}
+    var raw = atob("{b64}");
+    var bin = new Uint8Array(raw.length);
+    for (var i = 0; i < raw.length; i++) bin[i] = raw.charCodeAt(i);
+    el.innerHTML = new TextDecoder("utf-8").decode(bin);
+    var startMs = parseInt("{_sms}", 10);
+    function _garimFmtSec(sec) {{
+      if (!(sec >= 0) || sec === null || isNaN(sec)) return "—";
+      if (sec < 60) return (sec < 12 ? sec.toFixed(1) : Math.round(sec)) + "s";
+      if (sec < 3600) {{
+        var m = Math.floor(sec / 60), s = Math.floor(sec % 60);
+        return m + "m " + (s < 10 ? "0" : "") + s + "s";
+      }}
+      var h = Math.floor(sec / 3600), m2 = Math.floor((sec % 3600) / 60);
+      return h + "h " + (m2 < 10 ? "0" : "") + m2 + "m";
+    }}
+    if (window._garimOvInt) {{ clearInterval(window._garimOvInt); window._garimOvInt = null; }}
+    if (startMs > 0) {{
+      window._garimOvInt = setInterval(function() {{
+        var node = d.getElementById("garimpeiro-overlay-elapsed");
+        if (!node) return;
+        node.textContent = _garimFmtSec((Date.now() - startMs) / 1000);
+      }}, 200);
+      var n0 = d.getElementById("garimpeiro-overlay-elapsed");
+      if (n0) n0.textContent = _garimFmtSec((Date.now() - startMs) / 1000);
+    }}
+  }} catch (e) {{}}
+}})();
+</script>""",
+        height=0,
+        width=0,
+    )
+
+
+# --- TRABALHOS EM SEGUNDO PLANO (reler o lote, espelho na pasta, ZIP da Etapa 3) ---
+# Cada trabalho corre numa thread do servidor com o contexto da sessão: `st.session_state` funciona lá dentro,
+# mas nada é desenhado — o progresso que `_garim_footer_render` pintaria fica em contadores no registo do
+# processo, que a página lê num fragmento com `run_every`. Mexer noutros widgets ou fechar o separador não
+# interrompe a thread; o resultado fica no registo até ser aplicado à sessão (`ao_terminar`, na thread do script).
+SESSION_KEY_GARIM_TRABALHOS = "_garim_trabalhos"
+
+
+@st.cache_resource(show_spinner=False)
+def _garim_trabalhos_registo_processo():
+    """
+    Registo dos trabalhos e o seu lock, um por processo. O Streamlit volta a executar o app.py a cada rerun:
+    um dict global simples nasceria vazio na execução seguinte e a página perdia o trabalho que lançou.
+    """
+    return {}, threading.Lock()
+
+
+_GARIM_TRABALHOS, _GARIM_TRABALHOS_LOCK = _garim_trabalhos_registo_processo()
+_GARIM_TRABALHO_LOCAL = threading.local()
+_GARIM_TRABALHOS_INTERVALO_SEG = 2
+# Em exportações, o ponto de progresso/cancelamento corre a cada tantos XML.
+_GARIM_TRABALHO_PASSO_XML = 200
+# Trabalhos terminados que nenhuma página fechou (sessão perdida) saem do registo ao fim disto.
+_GARIM_TRABALHOS_RETENCAO_SEG = 6 * 3600
+
+
+class _GarimTrabalhoCancelado(BaseException):
+    """«Cancelar» num trabalho: sai no ponto de progresso seguinte (BaseException atravessa os `except Exception`)."""
+
+
+def _garim_trabalho_atual():
+    """Trabalho que esta thread está a executar, ou None (thread do script, linha de comando)."""
+    return getattr(_GARIM_TRABALHO_LOCAL, "trabalho", None)
+
+
+def _garim_trabalho_ponto(cur=None, total=None, arquivo=None, fase=None) -> None:
+    """Actualiza os contadores do trabalho desta thread e pára-o se foi cancelado; fora de um trabalho não faz nada."""
+    tr = _garim_trabalho_atual()
+    if tr is None:
+        return
+    if cur is not None:
+        tr["cur"] = int(cur)
+    if total is not None:
+        tr["total"] = max(1, int(total))
+    if arquivo is not None:
+        tr["arquivo"] = str(arquivo)
+    if fase is not None:
+        tr["fase"] = str(fase)
+    if tr["cancelar"].is_set():
+        raise _GarimTrabalhoCancelado()
+
+
+def _garim_trabalho_executar(tr, fn, args, kwargs) -> None:
+    _GARIM_TRABALHO_LOCAL.trabalho = tr
+    try:
+        tr["resultado"] = fn(*args, **kwargs)
+        tr["estado"] = "concluido"
+    except _GarimTrabalhoCancelado:
+        tr["estado"] = "cancelado"
+    except BaseException as e:
+        tr["erro"] = f"{type(e).__name__}: {e}"
+        tr["estado"] = "erro"
+    finally:
+        tr["t_fim"] = time.time()
+        _GARIM_TRABALHO_LOCAL.trabalho = None
+        gc.collect()
+
+
+def _garim_trabalhos_podar() -> None:
+    agora = time.time()
+    with _GARIM_TRABALHOS_LOCK:
+        for tid in [
+            t
+            for t, tr in _GARIM_TRABALHOS.items()
+            if tr["t_fim"] is not None and agora - tr["t_fim"] > _GARIM_TRABALHOS_RETENCAO_SEG
+        ]:
+            _GARIM_TRABALHOS.pop(tid, None)
+
+
+def _garim_trabalhos_da_sessao() -> list:
+    ids = st.session_state.get(SESSION_KEY_GARIM_TRABALHOS) or []
+    with _GARIM_TRABALHOS_LOCK:
+        return [_GARIM_TRABALHOS[t] for t in ids if t in _GARIM_TRABALHOS]
+
+
+def _garim_trabalho_ativo(tipo: str):
+    """Trabalho `tipo` desta sessão ainda a correr, ou None."""
+    for tr in _garim_trabalhos_da_sessao():
+        if tr["tipo"] == tipo and tr["estado"] == "a_correr":
+            return tr
+    return None
+
+
+def _garim_trabalho_iniciar(tipo: str, rotulo: str, fn, *args, ao_terminar=None, **kwargs):
+    """
+    Lança `fn(*args, **kwargs)` numa thread com o contexto desta sessão e junta-o aos trabalhos da sessão.
+    Um trabalho por `tipo` de cada vez (None se já houver um a correr). `ao_terminar(trabalho)` corre depois na
+    thread do script (`_garim_trabalhos_recolher`) para levar o resultado à sessão.
+    """
+    if _garim_trabalho_ativo(tipo) is not None:
+        return None
+    _garim_trabalhos_podar()
+    tr = {
+        "id": f"{tipo}_{os.urandom(6).hex()}",
+        "tipo": tipo,
+        "rotulo": rotulo,
+        "estado": "a_correr",
+        "cur": 0,
+        "total": 1,
+        "arquivo": "—",
+        "fase": "Início",
+        "t_start": time.time(),
+        "t_fim": None,
+        "resultado": None,
+        "erro": None,
+        "cancelar": threading.Event(),
+        "ao_terminar": ao_terminar,
+        "aplicado": False,
+        "mensagem": None,  # `ao_terminar` pode trocar o texto final do cartão (sucesso / aviso)
+        "aviso": None,
+    }
+    th = threading.Thread(
+        target=_garim_trabalho_executar,
+        args=(tr, fn, args, kwargs),
+        name=f"garimpeiro_{tipo}",
+        daemon=True,
+    )
+    try:
+        from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+        add_script_run_ctx(th, get_script_run_ctx())
+    except Exception:
+        pass
+    with _GARIM_TRABALHOS_LOCK:
+        _GARIM_TRABALHOS[tr["id"]] = tr
+    st.session_state[SESSION_KEY_GARIM_TRABALHOS] = list(
+        st.session_state.get(SESSION_KEY_GARIM_TRABALHOS) or []
+    ) + [tr["id"]]
+    th.start()
+    return tr
+
+
+def _garim_trabalho_fechar(tid: str) -> None:
+    st.session_state[SESSION_KEY_GARIM_TRABALHOS] = [
+        t for t in (st.session_state.get(SESSION_KEY_GARIM_TRABALHOS) or []) if t != tid
+    ]
+    with _GARIM_TRABALHOS_LOCK:
+        tr = _GARIM_TRABALHOS.get(tid)
+        if tr is not None and tr["estado"] != "a_correr":
+            _GARIM_TRABALHOS.pop(tid, None)
+
+
+def _garim_trabalhos_recolher() -> None:
+    """Na thread do script: leva à sessão, uma só vez, o resultado de cada trabalho terminado (`ao_terminar`)."""
+    for tr in _garim_trabalhos_da_sessao():
+        if tr["estado"] == "a_correr" or tr["aplicado"]:
+            continue
+        tr["aplicado"] = True
+        if tr["ao_terminar"] is None:
+            continue
+        try:
+            tr["ao_terminar"](tr)
+        except Exception as e:
+            tr["erro"] = f"{type(e).__name__}: {e}"
+            tr["estado"] = "erro"
+
+
+def _garim_trabalho_duracao(seg) -> str:
+    """Como `_garimFmtSec` do cartão de progresso: 9.5s, 4m 07s, 1h 02m."""
+    seg = max(0.0, float(seg or 0))
+    if seg < 60:
+        return f"{seg:.1f}s" if seg < 12 else f"{round(seg)}s"
+    if seg < 3600:
+        return f"{int(seg // 60)}m {int(seg % 60):02d}s"
+    return f"{int(seg // 3600)}h {int(seg % 3600 // 60):02d}m"
+
+
+def _garim_trabalhos_painel_corpo() -> None:
+    trs = _garim_trabalhos_da_sessao()
+    if any(tr["estado"] != "a_correr" and not tr["aplicado"] for tr in trs):
+        # Terminou entre duas voltas do fragmento: a página inteira aplica o resultado e redesenha o relatório.
+        st.rerun()
+    for tr in trs:
+        with st.container(border=True):
+            if tr["estado"] == "a_correr":
+                _arq = str(tr["arquivo"])
+                _arq = (_arq[:56] + "…") if len(_arq) > 58 else _arq
+                st.markdown(f"**{tr['rotulo']}** — em segundo plano; pode continuar a usar a página.")
+                st.progress(
+                    min(1.0, tr["cur"] / max(1, tr["total"])),
+                    text=f"{tr['fase']} · {_arq} · {tr['cur']}/{tr['total']} · "
+                    f"{_garim_trabalho_duracao(time.time() - tr['t_start'])}",
+                )
+                if tr["cancelar"].is_set():
+                    st.caption("A cancelar no próximo ponto seguro…")
+                elif st.button("Cancelar", key=f"btn_garim_trab_cancelar_{tr['id']}"):
+                    tr["cancelar"].set()
+                    st.rerun()
+                continue
+            _dur = _garim_trabalho_duracao((tr["t_fim"] or time.time()) - tr["t_start"])
+            if tr["estado"] == "cancelado":
+                st.warning(f"**{tr['rotulo']}** cancelado ao fim de {_dur}. O que já estava gravado ficou como estava.")
+            elif tr["estado"] == "erro":
+                st.error(f"**{tr['rotulo']}** falhou ao fim de {_dur}: {tr['erro']}")
+            elif tr["aviso"]:
+                st.warning(f"{tr['aviso']} ({_dur})")
+            else:
+                st.success(f"{tr['mensagem']} ({_dur})" if tr["mensagem"] else f"**{tr['rotulo']}** concluído em {_dur}.")
+            if st.button("Fechar", key=f"btn_garim_trab_fechar_{tr['id']}"):
+                _garim_trabalho_fechar(tr["id"])
+                st.rerun()
+
+
+def _garim_trabalhos_painel() -> None:
+    """Cartões dos trabalhos da sessão; enquanto algum corre, actualiza-se sozinho a cada poucos segundos."""
+    trs = _garim_trabalhos_da_sessao()
+    if not trs:
+        return
+    a_correr = any(tr["estado"] == "a_correr" for tr in trs)
+    if hasattr(st, "fragment"):
+        st.fragment(
+            _garim_trabalhos_painel_corpo,
+            run_every=_GARIM_TRABALHOS_INTERVALO_SEG if a_correr else None,
+        )()
+        return
+    _garim_trabalhos_painel_corpo()
+    if a_correr and st.button("Atualizar progresso", key="btn_garim_trab_atualizar"):
+        st.rerun()
+
+
+def _garim_trabalho_resync_espelho(cnpj_limpo: str):
+    """
+    «Atualizar arquivos salvos na pasta», 1.ª parte (em segundo plano): só lê o lote — a sessão não muda aqui.
+    Devolve {"nomes", "lote", "indice"} para `_garim_trabalho_resync_aplicar`, ou o par de `_garimpo_sync_feedback`.
+    """
+    cnpj = "".join(c for c in str(cnpj_limpo or "") if c.isdigit())[:14]
+    nomes, erro = _garimpo_reler_lote_fontes(cnpj)
+    if erro:
+        return ("err", erro)
+    lote, indice = _garimpo_reler_lote_ler(cnpj, nomes)
+    return {"nomes": nomes, "lote": lote, "indice": indice}
+
+
+def _garim_trabalho_resync_aplicar(tr, cnpj_limpo: str = "") -> None:
+    """
+    Na thread do script: troca o relatório pelo que o trabalho leu (só se terminou e o lote não mudou entretanto)
+    e lança a 2.ª parte, a regravação da pasta, com o relatório já novo.
+    """
+    r = tr["resultado"]
+    if isinstance(r, tuple):
+        st.session_state["_garimpo_sync_feedback"] = r
+        return
+    if not isinstance(r, dict):
+        return
+    if tr["estado"] != "concluido" or r["nomes"] != _lista_nomes_fontes_xml_garimpo():
+        _garimpo_lote_fechar(r["lote"])
+        if tr["estado"] == "concluido":
+            st.session_state["_garimpo_sync_feedback"] = (
+                "err",
+                "O lote mudou enquanto era relido (ficheiros incluídos ou removidos) — o relatório não foi "
+                "alterado. Carregue de novo em **Atualizar arquivos salvos na pasta**.",
+            )
+        return
+    okp, msgp = _garimpo_reler_lote_aplicar(r["nomes"], r["lote"], r["indice"])
+    if not okp:
+        st.session_state["_garimpo_sync_feedback"] = ("err", msgp)
+        return
+    tr["mensagem"] = f"**{tr['rotulo']}** — relatório atualizado."
+    _garim_trabalho_iniciar(
+        "resync_espelho",
+        "Regravar a pasta (espelho)",
+        _garimpo_resync_espelho_completo,
+        cnpj_limpo,
+        ao_terminar=lambda t, _msgp=msgp: _garim_trabalho_resync_pasta_aplicar(t, _msgp),
+    )
+
+
+def _garim_trabalho_resync_pasta_aplicar(tr, msgp: str) -> None:
+    if tr["estado"] != "concluido" or not tr["resultado"]:
+        st.session_state["_garimpo_sync_feedback"] = ("ok", msgp)
+        return
+    okr, msgr = tr["resultado"]
+    st.session_state["_garimpo_sync_feedback"] = ("ok", f"{msgp}\n\n{msgr}" if okr else f"{msgp}\n\n⚠ **Pasta:** {msgr}")
+    if not okr:
+        tr["aviso"] = f"**{tr['rotulo']}** terminou com problema — veja o aviso em baixo."
+
+
+def _garim_trabalho_espelho_aplicar(tr) -> None:
+    if tr["estado"] != "concluido":
+        return
+    if tr["resultado"]:
+        tr["mensagem"] = "Espelho gravado na pasta."
+        if getattr(st, "toast", None):
+            try:
+                st.toast("Espelho gravado na pasta (pastas + ZIP).", icon="✅")
+            except Exception:
+                pass
+        return
+    tr["aviso"] = "Gravação na pasta terminou com problema — veja o aviso em baixo."
+    _em = str(st.session_state.get("_garimpo_espelho_gravacao_erro") or "").strip()
+    if _em:
+        st.session_state["_garimpo_sync_feedback"] = ("err", f"**Espelho na pasta:** {_em}")
+
+
+# Ouvintes extra do progresso da leitura (ex.: linha de comando): fn(cur, total, arquivo, fase, t_start).
+_GARIM_PROGRESSO_OUVINTES: list = []
+
+
+def _garim_footer_render(placeholder, cur, total, arquivo, fase, t_start):
+    """
+    Atualiza o cartão global de progresso (topo do ecrã, fixo ao viewport).
+    `placeholder`, se não for None, é esvaziado — o conteúdo real vai para o `document` da janela principal.
+    Num trabalho em segundo plano só actualiza os contadores dele (e pára-o se foi cancelado).
+    """
+    if _garim_trabalho_atual() is not None:
+        _garim_trabalho_ponto(cur, total, arquivo, fase)
+        return
+    try:
+        _garim_footer_overlay_paint(cur, total, arquivo, fase, t_start)
+    except Exception:
+        pass
+    for _fn in _GARIM_PROGRESSO_OUVINTES:
+        try:
+            _fn(cur, total, arquivo, fase, t_start)
+        except Exception:
+            pass
+    if placeholder is not None:
+        try:
+            placeholder.empty()
+        except Exception:
+            pass
+
+
+def _garimpo_reler_lote_fontes(cnpj: str):
+    """(nomes das fontes, None) ou (None, mensagem) — o que `reprocessar_garimpeiro_a_partir_do_disco` valida antes de ler."""
+    if len(cnpj) != 14:
+        return None, "CNPJ inválido — confira a barra lateral."
+    if not _garimpo_existem_fontes_xml_lote():
+        if _garimpo_analise_sem_pasta_local_projeto():
+            return None, "Não há ficheiros do lote em memória. Faça **Iniciar grande garimpo** ou **Incluir mais XML**."
+        return None, "Pasta de uploads não existe."
+    nomes = _lista_nomes_fontes_xml_garimpo()
+    if not nomes:
+        return None, "Nenhum ficheiro no lote. Use «Incluir mais XML / ZIP» ou inicie um novo garimpo."
+    return nomes, None
+
+
+def _garimpo_reler_lote_ler(cnpj: str, nomes, footer_ph=None, t_start=None):
+    """
+    Leitura de `reprocessar_garimpeiro_a_partir_do_disco`: (lote, índice do lote) sem escrever na sessão — pode
+    correr num trabalho em segundo plano. Em erro / cancelamento o lote é fechado aqui.
+    """
+    if t_start is None:
+        t_start = time.time()
+    lote = _garimpo_lote_novo()
+    try:
+        indice_lote = _garimpo_indice_lote_novo(cnpj)
+        total_n = len(nomes)
+        _garim_footer_render(footer_ph, 0, max(1, total_n), "—", "Início", t_start)
+        with _garimpo_pool_identificacao() as _pool_ident:
+            for i, f_name in enumerate(nomes):
+                _garim_footer_render(footer_ph, i + 1, total_n, f_name, "Ler", t_start)
+                try:
+                    with _abrir_fonte_xml_garimpo_stream(f_name) as file_obj:
+                        _inner_xml_n = 0
+                        for name, _membros, _zinfo, res, is_p in _garimpo_identificar_fonte(
+                            _pool_ident, file_obj, f_name, cnpj
+                        ):
+                            _inner_xml_n += 1
+                            if (
+                                _inner_xml_n % _GARIM_GRANDE_GARIMPO_REFRESH_XML_A_CADA
+                                == 0
+                            ):
+                                _garim_footer_render(
+                                    footer_ph,
+                                    i + 1,
+                                    total_n,
+                                    f_name,
+                                    f"{_inner_xml_n} xml · {_garimpo_lote_n(lote)}"
+                                    + _garimpo_cache_ident_resumo(_pool_ident),
+                                    t_start,
+                                )
+                            if res:
+                                _garimpo_indice_lote_registar(
+                                    indice_lote, f_name, name, _membros, _zinfo, res, is_p
+                                )
+                                _garimpo_lote_registar(lote, res, is_p)
+                except MemoryError:
+                    # Sem memória o lote ficaria incompleto em silêncio (ex.: limite por trabalho do lote de clientes).
+                    raise
+                except Exception:
+                    continue
+    except BaseException:
+        _garimpo_lote_fechar(lote)
+        raise
+    return lote, indice_lote
+
+
+def _garimpo_reler_lote_aplicar(nomes, lote, indice_lote):
+    """
+    Escrita de `reprocessar_garimpeiro_a_partir_do_disco`, na thread do script: troca de uma vez o relatório
+    (com os registos manuais que a sessão tiver **agora**) e recalcula os DataFrames. Fecha o lote.
+    """
+    try:
+        _garimpo_indice_lote_guardar(indice_lote, nomes)
+
+        n_docs = _garimpo_lote_n(lote)
+        if not n_docs:
+            return (
+                False,
+                "Nenhum documento reconhecido ao reler a pasta (verifique CNPJ e ficheiros). O relatório não foi alterado.",
+            )
+
+        rel_atual = st.session_state.get("relatorio")
+        manuais = [
+            r
+            for r in _relatorio_iter_especiais(rel_atual)
+            if _inutil_sem_xml_manual(r) or _cancel_sem_xml_manual(r)
+        ]
+
+        st.session_state["relatorio"] = _relatorio_colunar_de_itens(
+            (res for res, _is_p in _garimpo_lote_itens(lote)), manuais
+        )
+        _garimpo_lote_fechar(lote)
+        st.session_state["export_ready"] = False
+        st.session_state["excel_buffer"] = None
+        if st.session_state.get("validation_done"):
+            st.session_state["validation_done"] = False
+        st.session_state.pop("df_divergencias", None)
+        for _pfx in (
+            "rep_bur",
+            "rep_inu",
+            "rep_canc",
+            "rep_aut",
+            "rep_den",
+            "rep_rej",
+            "rep_ger",
+            "rep_canc_t",
+            "rep_aut_t",
+            "rep_den_t",
+            "rep_rej_t",
+            "rep_ger_t",
+        ):
+            st.session_state.pop(f"{_pfx}_zip_parts_ready", None)
+            st.session_state.pop(f"{_pfx}_zip_src_sig", None)
+
+        reconstruir_dataframes_relatorio_simples()
+
+        _n_inm = sum(1 for r in manuais if _inutil_sem_xml_manual(r))
+        _n_cam = sum(1 for r in manuais if _cancel_sem_xml_manual(r))
+        return (
+            True,
+            f"Concluído: {len(nomes)} ficheiro(s) lidos, {n_docs} documento(s) únicos; "
+            f"{len(manuais)} registo(s) manual(is) mantido(s) ({_n_inm} inutil., {_n_cam} cancel.).",
+        )
+    finally:
+        _garimpo_lote_fechar(lote)
+
+
+def _garim_trabalho_garimpo_aplicar(tr, cnpj_limpo: str, nomes, up_ini_inut=None, up_ini_canc=None) -> None:
+    """
+    «Iniciar grande garimpo», 2.ª parte, na thread do script: com o lote lido em segundo plano
+    (`_garimpo_reler_lote_ler`) monta o relatório e a auditoria de buracos, aplica as planilhas do passo 2 e
+    escreve a sessão — só se a leitura terminou e o lote não mudou entretanto.
+    """
+    r = tr["resultado"]
+    if tr["estado"] != "concluido" or not r:
+        return
+    lote, indice_lote = r
+    try:
+        if nomes != _lista_nomes_fontes_xml_garimpo():
+            tr["aviso"] = (
+                "O lote mudou enquanto era lido (ficheiros incluídos ou removidos) — o relatório não foi montado. "
+                "Carregue de novo em **Iniciar grande garimpo**."
+            )
+            return
+        _garimpo_indice_lote_guardar(indice_lote, nomes)
+
+        ref_ar, ref_mr, ref_map = buraco_ctx_sessao()
+        audit_map = {}
+        # Documentos já em colunas (as tabelas por linha saem delas no fim); no resumo as
+        # inutilizações entram como faixas nNFIni–nNFFin, sem um número de cada vez.
+        rel_list = _relatorio_colunar_de_itens(res for res, _is_p in _garimpo_lote_itens(lote))
+
+        for res, is_p in _garimpo_lote_itens(lote):
+            if not is_p:
+                continue
+            sk = (res["Tipo"], res["Série"])
+            ult_u = ultimo_ref_lookup(ref_map, res["Tipo"], res["Série"])
+
+            if res["Status"] == "INUTILIZADOS":
+                ra, rb = res.get("Range", (res["Número"], res["Número"]))
+                if ra <= rb and _incluir_em_resumo_por_serie(res, is_p, cnpj_limpo):
+                    if sk not in audit_map:
+                        audit_map[sk] = {"nums": set(), "nums_buraco": set(), "faixas": [], "faixas_buraco": [], "valor": 0.0}
+                    audit_map[sk]["faixas"].append((ra, rb))
+                    if _inutil_sem_xml_manual(res):
+                        audit_map[sk]["faixas_buraco"].append((ra, rb))
+                    else:
+                        _faixa_b = _buraco_faixa_inut(res["Ano"], res["Mes"], ra, rb, ref_ar, ref_mr, ult_u)
+                        if _faixa_b is not None:
+                            audit_map[sk]["faixas_buraco"].append(_faixa_b)
+            elif (
+                res["Status"] not in ("DENEGADOS", "REJEITADOS")
+                and res["Número"] > 0
+                and _incluir_em_resumo_por_serie(res, is_p, cnpj_limpo)
+            ):
+                if sk not in audit_map:
+                    audit_map[sk] = {"nums": set(), "nums_buraco": set(), "faixas": [], "faixas_buraco": [], "valor": 0.0}
+                audit_map[sk]["nums"].add(res["Número"])
+                if _cancel_sem_xml_manual(res):
+                    audit_map[sk]["nums_buraco"].add(res["Número"])
+                elif incluir_numero_no_conjunto_buraco(
+                    res["Ano"],
+                    res["Mes"],
+                    res["Número"],
+                    ref_ar,
+                    ref_mr,
+                    ult_u,
+                ):
+                    audit_map[sk]["nums_buraco"].add(res["Número"])
+                audit_map[sk]["valor"] += res["Valor"]
+    finally:
+        _garimpo_lote_fechar(lote)
+
+    if not rel_list["n"]:
+        st.session_state["garimpo_ok"] = False
+        tr["aviso"] = (
+            f"**{len(nomes)} ficheiro(s)** processados, mas **0 documentos** reconhecidos como NF-e/NFC-e. "
+            "Confirme o **CNPJ** na barra (14 dígitos = **emitente** nos XML), que os ficheiros são XML de nota válidos "
+            "e que os ZIP contêm `.xml` (não só PDF ou outro formato)."
+        )
+        return
+
+    res_final = []
+    fal_faixas = []
+
+    for (t, s), dados in audit_map.items():
+        _linha_resumo, _faixas = _relatorio_linhas_serie(
+            (t, s),
+            dados["nums"],
+            dados["nums_buraco"],
+            dados["valor"],
+            ref_ar,
+            ref_map,
+            dados["faixas"],
+            dados["faixas_buraco"],
+        )
+        if _linha_resumo is not None:
+            res_final.append(_linha_resumo)
+        fal_faixas.append((t, s, _faixas))
+    df_fal = df_faltantes_de_faixas(fal_faixas)
+    del fal_faixas
+
+    _garimpo_hidratar_sped_sessao_do_widget_ini()
+
+    _u_inut = up_ini_inut or st.session_state.get("garimpo_ini_inut")
+    _u_canc = up_ini_canc or st.session_state.get("garimpo_ini_canc")
+    _txt_inut_ini = str(st.session_state.get("garimpo_ini_inut_paste") or "").strip()
+    _pl_ini = _garimpo_aplicar_planilhas_inutil_cancel_no_relatorio(
+        rel_list,
+        cnpj_limpo,
+        df_fal,
+        _u_inut,
+        _u_canc,
+        texto_inut_colar=_txt_inut_ini or None,
+    )
+    if _pl_ini.get("msgs"):
+        st.session_state["_garimpo_ini_avisos_planilhas"] = _pl_ini["msgs"]
+    else:
+        st.session_state.pop("_garimpo_ini_avisos_planilhas", None)
+
+    st.session_state["relatorio"] = rel_list
+    _session_state_pop_garimpo(SESSION_KEY_RELATORIO_INCREMENTAL)
+    if (_pl_ini.get("inut", 0) + _pl_ini.get("canc", 0)) > 0:
+        reconstruir_dataframes_relatorio_simples()
+    else:
+        _esp_ini = {}
+        for _i in sorted(rel_list["literais"]):
+            _it = rel_list["literais"][_i]
+            _p = "EMITIDOS_CLIENTE" in _it["Pasta"]
+            _esp_ini[_i] = _relatorio_linhas_item(
+                _it, _p, {}, cnpj_limpo, ref_ar, ref_mr, ref_map
+            )[:4] + (_p,)
+        _dfs_ini, _donos_ini = _relatorio_dfs_de_vencedores(
+            rel_list, list(range(rel_list["n"])), _esp_ini
+        )
+        del _esp_ini, _donos_ini
+        st.session_state.update(
+            {
+                "df_resumo": pd.DataFrame(res_final),
+                "df_faltantes": df_fal,
+                **_dfs_ini,
+            }
+        )
+        _relatorio_st_counts_atualizar()
+        aplicar_compactacao_dfs_sessao()
+        _garimpo_registar_aviso_sped_chaves_sem_xml_no_lote(
+            st.session_state.get("df_geral"),
+            _sped_fonte_sessao(),
+        )
+    if (
+        st.session_state.get("garimpo_lote_espelho_root")
+        and not _streamlit_likely_community_cloud()
+    ):
+        # 1 = mostrar relatório primeiro; 2 = gravar espelho no rerun seguinte
+        st.session_state[SESSION_KEY_GARIMPO_ESPELHO_WRITE_PHASE] = 1
+    st.session_state["garimpo_ok"] = True
+    st.session_state["export_ready"] = False
+    st.session_state["excel_buffer"] = None
+    tr["mensagem"] = f"**{tr['rotulo']}** — {len(nomes)} ficheiro(s) lidos, {rel_list['n']} documento(s) únicos."
+
+
+def reprocessar_garimpeiro_a_partir_do_disco(cnpj_limpo: str, footer_ph=None, t_start=None):
+    """
+    Relê todos os XML/ZIP do lote (memória da sessão ou TEMP_UPLOADS_DIR), mesmas regras de fusão por chave,
+    mantém registos manuais de inutilização e de cancelamento «sem XML» e recalcula os dataframes.
+    Em segundo plano usa-se as duas metades em separado (`_garim_trabalho_resync_espelho`).
+    """
+    cnpj = "".join(c for c in str(cnpj_limpo or "") if c.isdigit())[:14]
+    nomes, erro = _garimpo_reler_lote_fontes(cnpj)
+    if erro:
+        return False, erro
+    try:
+        lote, indice_lote = _garimpo_reler_lote_ler(cnpj, nomes, footer_ph, t_start)
+        return _garimpo_reler_lote_aplicar(nomes, lote, indice_lote)
+    finally:
+        _garim_footer_overlay_remove()
+
+
+
+def _relatorio_ja_tem_chave(chave: str) -> bool:
+    return _relatorio_tem_chave(st.session_state.get("relatorio"), chave)
+
+
+def processar_painel_lateral_direito(
+    cnpj_limpo: str,
+    extra_files,
+    pick_bur_inut,
+    mb_bur,
+    sb_bur,
+    up_inut_planilha,
+    mf_faixa,
+    sf_faixa,
+    n0_faixa,
+    n1_faixa,
+    pick_bur_canc=None,
+    mb_canc=None,
+    sb_canc=None,
+    up_canc_planilha=None,
+    mf_canc_f=None,
+    sf_canc_f=None,
+    n0_canc_f=None,
+    n1_canc_f=None,
+    up_autent_sefaz=None,
+    footer_ph=None,
+    t_start=None,
+    texto_inut_planilha=None,
+    texto_canc_planilha=None,
+):
+    """
+    Um único passo: grava XML/ZIP extra em disco, aplica inutilizações e canceladas manuais
+    (buracos / planilha / faixa, mesmas regras), recalcula a partir do disco (ou só reconstrói)
+    e, se anexar planilha(s), compara autenticidade Sefaz Ã— XML (vários Excel/CSV são agregados).
+    """
+    cnpj = "".join(c for c in str(cnpj_limpo or "") if c.isdigit())[:14]
+    linhas = []
+    n_extra = 0
+    if extra_files:
+        n_extra = _garimpo_absorver_uploads_extra_no_lote(extra_files)
+        if n_extra:
+            _lbl = (
+                "**em memória** (e/ou pasta temp, conforme configuração)"
+                if _garimpo_analise_sem_pasta_local_projeto()
+                else "**na pasta de uploads**"
+            )
+            linhas.append(f"**{n_extra}** ficheiro(s) extra incorporado(s) ao lote {_lbl}.")
+
+    n_b = 0
+    if pick_bur_inut:
+        if mb_bur is None or sb_bur is None or str(sb_bur).strip() == "":
+            return (
+                False,
+                "Para aplicar notas em «Dos buracos», escolha **modelo** e **série** nesse separador.",
+                linhas,
+            )
+        for _nb in pick_bur_inut:
+            _it = item_registro_manual_inutilizado(cnpj_limpo, mb_bur, sb_bur, _nb)
+            if not _relatorio_ja_tem_chave(_it["Chave"]) and not _registro_manual_inutil_duplicada(
+                st.session_state["relatorio"], mb_bur, sb_bur, _nb
+            ):
+                _relatorio_anexar(st.session_state["relatorio"], _it)
+                n_b += 1
+        if n_b:
+            linhas.append(f"**{n_b}** inutilização(ões) a partir dos buracos.")
+
+    n_p = 0
+    err_p = None
+    _dfs_inut = []
+    _warns_inut = []
+    if up_inut_planilha is not None:
+        _df_up, _err_up = dataframe_de_upload_inutil(up_inut_planilha)
+        if _err_up:
+            _warns_inut.append(f"Ficheiro inutilizadas: {_err_up}")
+        elif _df_up is not None and not _df_up.empty:
+            _dfs_inut.append(_df_up)
+    if texto_inut_planilha and str(texto_inut_planilha).strip():
+        _df_pc, _err_pc = dataframe_de_texto_colar_planilha(str(texto_inut_planilha).strip())
+        if _err_pc:
+            _warns_inut.append(f"Texto colado (inutilizadas): {_err_pc}")
+        elif _df_pc is not None and not _df_pc.empty:
+            _dfs_inut.append(_df_pc)
+    if _dfs_inut:
+        _df_merged = (
+            pd.concat(_dfs_inut, ignore_index=True) if len(_dfs_inut) > 1 else _dfs_inut[0]
+        )
+        _tri, _err_tr = triplas_inutil_de_dataframe(_df_merged)
+        if _err_tr:
+            err_p = _err_tr
+        else:
+            _df_bu = st.session_state["df_faltantes"].copy()
+            _bur_t = conjunto_triplas_buracos(_df_bu)
+            if not _bur_t:
+                err_p = "Não há buracos na auditoria — nada importado da planilha/texto."
+            else:
+                _aplic_rows = []
+                _ign = 0
+                _seen = set()
+                for _mod, _ser, _nota in _tri:
+                    _k = (_mod.strip(), str(_ser).strip(), int(_nota))
+                    if _k not in _bur_t:
+                        _ign += 1
+                        continue
+                    if _k in _seen:
+                        continue
+                    _seen.add(_k)
+                    _aplic_rows.append((_mod.strip(), str(_ser).strip(), int(_nota)))
+                if not _aplic_rows:
+                    err_p = "Nenhuma linha da planilha/texto coincide com buraco listado."
+                else:
+                    n_p = 0
+                    for _mod, _ser, _nota in _aplic_rows:
+                        _itp = item_registro_manual_inutilizado(cnpj_limpo, _mod, _ser, _nota)
+                        if not _relatorio_ja_tem_chave(_itp["Chave"]) and not _registro_manual_inutil_duplicada(
+                            st.session_state["relatorio"], _mod, _ser, _nota
+                        ):
+                            _relatorio_anexar(st.session_state["relatorio"], _itp)
+                            n_p += 1
+                    if n_p:
+                        linhas.append(f"**{n_p}** linha(s) da planilha/texto (buracos).")
+                    elif _aplic_rows:
+                        linhas.append("Planilha/texto: linhas já presentes no relatório (sem duplicar).")
+                    if _ign > 0:
+                        linhas.append(f"({_ign} linha(s) ignoradas — não eram buraco.)")
+        if _warns_inut:
+            linhas.append("**Aviso:** " + " ".join(_warns_inut))
+    elif _warns_inut:
+        err_p = " ".join(_warns_inut)
+
+    _MAX_FAIXA_INUT = 5000
+    n_f = 0
+    err_f = None
+    df_fb = st.session_state["df_faltantes"].copy()
+    if not df_fb.empty and "Serie" in df_fb.columns and "Série" not in df_fb.columns:
+        df_fb = df_fb.rename(columns={"Serie": "Série"})
+    _bur_f = set()
+    if (
+        not df_fb.empty
+        and {"Tipo", "Série", "Num_Faltante"}.issubset(df_fb.columns)
+    ):
+        _subf = df_fb[
+            (df_fb["Tipo"].astype(str) == mf_faixa)
+            & (df_fb["Série"].astype(str) == str(sf_faixa).strip())
+        ]
+        _bur_f = set(_subf["Num_Faltante"].astype(int).unique())
+    if not sf_faixa or not str(sf_faixa).strip():
+        pass
+    elif n0_faixa > n1_faixa:
+        err_f = "Faixa: a nota inicial não pode ser maior que a final."
+    elif (n1_faixa - n0_faixa + 1) > _MAX_FAIXA_INUT:
+        err_f = f"Faixa: máximo {_MAX_FAIXA_INUT} notas."
+    elif not _bur_f:
+        err_f = "Faixa: não há buracos para este modelo/série."
+    else:
+        _aplic = [n for n in range(int(n0_faixa), int(n1_faixa) + 1) if n in _bur_f]
+        if _aplic:
+            n_f = 0
+            for _nn in _aplic:
+                _itf = item_registro_manual_inutilizado(
+                    cnpj_limpo, mf_faixa, str(sf_faixa).strip(), _nn
+                )
+                if not _relatorio_ja_tem_chave(_itf["Chave"]) and not _registro_manual_inutil_duplicada(
+                    st.session_state["relatorio"], mf_faixa, str(sf_faixa).strip(), _nn
+                ):
+                    _relatorio_anexar(st.session_state["relatorio"], _itf)
+                    n_f += 1
+            if n_f:
+                linhas.append(f"**{n_f}** nota(s) da faixa (buracos).")
+
+    pick_bc = list(pick_bur_canc or [])
+    n_b_c = 0
+    if pick_bc:
+        if mb_canc is None or sb_canc is None or str(sb_canc).strip() == "":
+            return (
+                False,
+                "Para aplicar canceladas em «Dos buracos», escolha **modelo** e **série** nesse separador.",
+                linhas,
+            )
+        for _nb in pick_bc:
+            _itc = item_registro_manual_cancelado(cnpj_limpo, mb_canc, sb_canc, _nb)
+            if not _relatorio_ja_tem_chave(_itc["Chave"]) and not _registro_manual_cancel_duplicada(
+                st.session_state["relatorio"], mb_canc, sb_canc, _nb
+            ):
+                _relatorio_anexar(st.session_state["relatorio"], _itc)
+                n_b_c += 1
+        if n_b_c:
+            linhas.append(f"**{n_b_c}** cancelada(s) a partir dos buracos.")
+
+    n_p_c = 0
+    err_p_c = None
+    _dfs_canc = []
+    _warns_canc = []
+    if up_canc_planilha is not None:
+        _df_uc, _err_uc = dataframe_de_upload_inutil(up_canc_planilha)
+        if _err_uc:
+            _warns_canc.append(f"Ficheiro canceladas: {_err_uc}")
+        elif _df_uc is not None and not _df_uc.empty:
+            _dfs_canc.append(_df_uc)
+    if texto_canc_planilha and str(texto_canc_planilha).strip():
+        _df_cc, _err_cc = dataframe_de_texto_colar_planilha(str(texto_canc_planilha).strip())
+        if _err_cc:
+            _warns_canc.append(f"Texto colado (canceladas): {_err_cc}")
+        elif _df_cc is not None and not _df_cc.empty:
+            _dfs_canc.append(_df_cc)
+    if _dfs_canc:
+        _df_cmerged = (
+            pd.concat(_dfs_canc, ignore_index=True) if len(_dfs_canc) > 1 else _dfs_canc[0]
+        )
+        _trc, _err_trc = triplas_inutil_de_dataframe(_df_cmerged)
+        if _err_trc:
+            err_p_c = _err_trc
+        else:
+            _df_buc = st.session_state["df_faltantes"].copy()
+            _bur_tc = conjunto_triplas_buracos(_df_buc)
+            if not _bur_tc:
+                err_p_c = "Canceladas — não há buracos na auditoria — nada importado da planilha/texto."
+            else:
+                _aplic_c = []
+                _ign_c = 0
+                _seen_c = set()
+                for _mod, _ser, _nota in _trc:
+                    _k = (_mod.strip(), str(_ser).strip(), int(_nota))
+                    if _k not in _bur_tc:
+                        _ign_c += 1
+                        continue
+                    if _k in _seen_c:
+                        continue
+                    _seen_c.add(_k)
+                    _aplic_c.append((_mod.strip(), str(_ser).strip(), int(_nota)))
+                if not _aplic_c:
+                    err_p_c = "Canceladas — nenhuma linha da planilha/texto coincide com buraco listado."
+                else:
+                    for _mod, _ser, _nota in _aplic_c:
+                        _itpc = item_registro_manual_cancelado(cnpj_limpo, _mod, _ser, _nota)
+                        if not _relatorio_ja_tem_chave(_itpc["Chave"]) and not _registro_manual_cancel_duplicada(
+                            st.session_state["relatorio"], _mod, _ser, _nota
+                        ):
+                            _relatorio_anexar(st.session_state["relatorio"], _itpc)
+                            n_p_c += 1
+                    if n_p_c:
+                        linhas.append(f"**{n_p_c}** linha(s) da planilha/texto de **canceladas** (buracos).")
+                    elif _aplic_c:
+                        linhas.append("Planilha/texto canceladas: linhas já presentes no relatório (sem duplicar).")
+                    if _ign_c > 0:
+                        linhas.append(f"({_ign_c} linha(s) ignoradas nas canceladas — não eram buraco.)")
+        if _warns_canc:
+            linhas.append("**Aviso:** " + " ".join(_warns_canc))
+    elif _warns_canc:
+        err_p_c = " ".join(_warns_canc)
+
+    _MAX_FAIXA_CANC = 5000
+    n_f_c = 0
+    err_f_c = None
+    df_fbc = st.session_state["df_faltantes"].copy()
+    if not df_fbc.empty and "Serie" in df_fbc.columns and "Série" not in df_fbc.columns:
+        df_fbc = df_fbc.rename(columns={"Serie": "Série"})
+    _bur_fc = set()
+    _mfc = mf_canc_f if mf_canc_f is not None else "NF-e"
+    _sfc = (sf_canc_f if sf_canc_f is not None else "1") or "1"
+    _n0c = int(n0_canc_f if n0_canc_f is not None else 1)
+    _n1c = int(n1_canc_f if n1_canc_f is not None else 1)
+    if (
+        not df_fbc.empty
+        and {"Tipo", "Série", "Num_Faltante"}.issubset(df_fbc.columns)
+    ):
+        _subfc = df_fbc[
+            (df_fbc["Tipo"].astype(str) == _mfc)
+            & (df_fbc["Série"].astype(str) == str(_sfc).strip())
+        ]
+        _bur_fc = set(_subfc["Num_Faltante"].astype(int).unique())
+    if not str(_sfc).strip():
+        pass
+    elif _n0c > _n1c:
+        err_f_c = "Canceladas — faixa: a nota inicial não pode ser maior que a final."
+    elif (_n1c - _n0c + 1) > _MAX_FAIXA_CANC:
+        err_f_c = f"Canceladas — faixa: máximo {_MAX_FAIXA_CANC} notas."
+    elif not _bur_fc:
+        err_f_c = "Canceladas — faixa: não há buracos para este modelo/série."
+    else:
+        _aplic_fc = [n for n in range(int(_n0c), int(_n1c) + 1) if n in _bur_fc]
+        if _aplic_fc:
+            for _nn in _aplic_fc:
+                _itfc = item_registro_manual_cancelado(cnpj_limpo, _mfc, str(_sfc).strip(), _nn)
+                if not _relatorio_ja_tem_chave(_itfc["Chave"]) and not _registro_manual_cancel_duplicada(
+                    st.session_state["relatorio"], _mfc, str(_sfc).strip(), _nn
+                ):
+                    _relatorio_anexar(st.session_state["relatorio"], _itfc)
+                    n_f_c += 1
+            if n_f_c:
+                linhas.append(f"**{n_f_c}** nota(s) da faixa de **canceladas** (buracos).")
+
+    tem_ficheiros = _garimpo_existem_fontes_xml_lote()
+    fez_algo = (
+        n_extra > 0
+        or n_b > 0
+        or n_p > 0
+        or n_f > 0
+        or n_b_c > 0
+        or n_p_c > 0
+        or n_f_c > 0
+    )
+    quer_compare_autent = _tem_upload_autenticidade(up_autent_sefaz)
+
+    if err_p:
+        return False, err_p, linhas
+    if err_p_c:
+        return False, err_p_c, linhas
+    if (err_f or err_f_c) and not fez_algo and not tem_ficheiros and not quer_compare_autent:
+        _msg_ff = err_f or err_f_c
+        return False, _msg_ff, linhas
+    if err_f:
+        linhas.append(f"Aviso (faixa inutil.): {err_f}")
+    if err_f_c:
+        linhas.append(f"Aviso (faixa cancel.): {err_f_c}")
+
+    if not fez_algo and not tem_ficheiros and not quer_compare_autent:
+        return (
+            False,
+            "Nada a processar: inclua XML/ZIP, inutilizações / canceladas manuais, "
+            "o **relatório de autenticidade** (Sefaz) ou faça o garimpo para haver ficheiros em disco.",
+            linhas,
+        )
+
+    if not quer_compare_autent and (fez_algo or tem_ficheiros):
+        st.session_state.pop("df_divergencias", None)
+        st.session_state["validation_done"] = False
+
+    st.session_state["export_ready"] = False
+    st.session_state["excel_buffer"] = None
+
+    if tem_ficheiros:
+        if len(cnpj) != 14:
+            return False, "CNPJ inválido na barra lateral — necessário para reler os XML.", linhas
+        ok, msg_rep = reprocessar_garimpeiro_a_partir_do_disco(
+            cnpj_limpo, footer_ph=footer_ph, t_start=t_start
+        )
+        if not ok:
+            return False, msg_rep, linhas
+        linhas.append(msg_rep)
+        if quer_compare_autent:
+            ok_a, msg_a = _aplicar_comparacao_autenticidade(up_autent_sefaz)
+            if not ok_a:
+                return False, msg_a, linhas
+            linhas.append(msg_a)
+        return True, "\n\n".join(linhas), linhas
+
+    reconstruir_dataframes_relatorio_simples()
+    linhas.append(
+        "Relatório recalculado (sem ficheiros na pasta de uploads — só registos manuais de inutil. / cancel.)."
+    )
+    if quer_compare_autent:
+        ok_a, msg_a = _aplicar_comparacao_autenticidade(up_autent_sefaz)
+        if not ok_a:
+            return False, msg_a, linhas
+        linhas.append(msg_a)
+    return True, "\n\n".join(linhas), linhas
+
+
+_V2_STATUS_UI_PARA_DF = {
+    "Autorizadas": ["NORMAIS"],
+    "Canceladas": ["CANCELADOS"],
+    "Inutilizadas": ["INUTILIZADOS", "INUTILIZADA"],
+    "Denegadas": ["DENEGADOS"],
+    "Rejeitadas": ["REJEITADOS"],
+}
+_V2_OP_UI_PARA_INTERNO = {"Entrada": "ENTRADA", "Saída": "SAIDA"}
+_V2_DATA_MODELO_LABELS = ("Qualquer", "Maior ou igual a", "Menor ou igual a", "Igual a", "Entre")
+_V2_FAIXA_MODELO_LABELS = _V2_DATA_MODELO_LABELS
+
+
+def v2_status_labels_para_valores(labels):
+    out = []
+    for L in labels or []:
+        out.extend(_V2_STATUS_UI_PARA_DF.get(L, []))
+    return list(dict.fromkeys(out))
+
+
+def v2_op_labels_para_interno(labels):
+    return [_V2_OP_UI_PARA_INTERNO[x] for x in (labels or []) if x in _V2_OP_UI_PARA_INTERNO]
+
+
+def _mask_emissao_propria_df(df: pd.DataFrame) -> pd.Series:
+    if df is None or df.empty or "Origem" not in df.columns:
+        return pd.Series(dtype=bool)
+    o = df["Origem"].astype(str)
+    return o.str.contains("PRÓPRIA|PROPRIA", case=False, na=False, regex=True)
+
+
+def _v2_parse_modo_data(label: str) -> str:
+    return {
+        "Qualquer": "",
+        "Maior ou igual a": ">=",
+        "Menor ou igual a": "<=",
+        "Igual a": "=",
+        "Entre": "entre",
+    }.get(label or "", "")
+
+
+def _v2_parse_modo_faixa(label: str) -> str:
+    return _v2_parse_modo_data(label)
+
+
+def _v2_aplicar_filtro_data_emissao(df_p: pd.DataFrame, modo: str, d1, d2) -> pd.DataFrame:
+    if df_p.empty or not modo or "Data Emissão" not in df_p.columns:
+        return df_p
+    dt = pd.to_datetime(df_p["Data Emissão"], errors="coerce").dt.normalize()
+    if d1 is not None:
+        t1 = pd.Timestamp(d1).normalize()
+    else:
+        t1 = None
+    if d2 is not None:
+        t2 = pd.Timestamp(d2).normalize()
+    else:
+        t2 = None
+    if modo == ">=" and t1 is not None:
+        return df_p.loc[dt >= t1]
+    if modo == "<=" and t1 is not None:
+        return df_p.loc[dt <= t1]
+    if modo == "=" and t1 is not None:
+        return df_p.loc[dt == t1]
+    if modo == "entre" and t1 is not None and t2 is not None:
+        lo, hi = min(t1, t2), max(t1, t2)
+        return df_p.loc[(dt >= lo) & (dt <= hi)]
+    return df_p
+
+
+def _v2_aplicar_filtro_faixa_nota(df_p: pd.DataFrame, modo: str, n1: int, n2: int) -> pd.DataFrame:
+    if df_p.empty or not modo or "Nota" not in df_p.columns:
+        return df_p
+    nn = pd.to_numeric(df_p["Nota"], errors="coerce")
+    if modo == ">=":
+        return df_p.loc[nn >= n1]
+    if modo == "<=":
+        return df_p.loc[nn <= n1]
+    if modo == "=":
+        return df_p.loc[nn == n1]
+    if modo == "entre":
+        lo, hi = min(n1, n2), max(n1, n2)
+        return df_p.loc[(nn >= lo) & (nn <= hi)]
+    return df_p
+
+
+# --- ÍNDICE DE FILTROS DA ETAPA 3 ---
+# `filtrar_df_geral_para_exportacao` corre várias vezes por interação (cascata Série/UF + pré-visualização +
+# exportação). Em vez de copiar o relatório e aplicar `str.contains` / `isin` / `str.upper` à coluna inteira
+# a cada chamada, cada coluna categórica é fatorizada uma vez por `df_geral` (códigos por linha + valores
+# distintos): um critério avalia-se sobre os distintos (as mesmas operações pandas de antes) e expande-se
+# para as linhas por indexação dos códigos. Data e Nota ficam já convertidas. Os filtros combinam-se com
+# `&` sobre arrays booleanos e devolvem posições de linha, memorizadas por assinatura dos filtros.
+_V2_IDX_COLUNAS = ("Origem", "Modelo", "Série", "Status Final", "Operação", "UF Destino", "Chave")
+_V2_IDX_MAX_POSICOES = 16
+
+
+def _mask_emissao_propria_df_distintos(s: pd.Series) -> pd.Series:
+    return _mask_emissao_propria_df(pd.DataFrame({"Origem": s}))
+
+
+def _v2_indice_filtros_calcular(df: pd.DataFrame) -> dict:
+    idx = {"n": len(df), "cols": {}, "posicoes": {}}
+    for c in _V2_IDX_COLUNAS:
+        if c not in df.columns:
+            continue
+        codigos, unicos = pd.factorize(df[c], use_na_sentinel=True)
+        # O código -1 (NaN) passa a apontar para um último valor NaN do mesmo dtype.
+        distintos = pd.concat(
+            [pd.Series(unicos, dtype=df[c].dtype), pd.Series([np.nan], dtype=df[c].dtype)],
+            ignore_index=True,
+        )
+        codigos = np.where(codigos < 0, len(unicos), codigos)
+        idx["cols"][c] = (codigos, distintos)
+    if "Data Emissão" in df.columns:
+        idx["data"] = (
+            pd.to_datetime(df["Data Emissão"], errors="coerce").dt.normalize().to_numpy(dtype="datetime64[ns]")
+        )
+    if "Nota" in df.columns:
+        idx["nota"] = pd.to_numeric(df["Nota"], errors="coerce").to_numpy(dtype="float64", na_value=np.nan)
+    idx["propria"] = (
+        _v2_idx_mask(idx, "Origem", _mask_emissao_propria_df_distintos)
+        if "Origem" in idx["cols"]
+        else np.zeros(len(df), dtype=bool)
+    )
+    return idx
+
+
+def _v2_idx_mask(idx: dict, col: str, criterio) -> np.ndarray:
+    """`criterio(Series)` → bool, avaliado nos valores distintos de `col` e expandido para todas as linhas."""
+    codigos, distintos = idx["cols"][col]
+    r = criterio(distintos)
+    return np.asarray(pd.Series(r).fillna(False).to_numpy(dtype=bool))[codigos]
+
+
+def _v2_indice_filtros(df: pd.DataFrame) -> dict:
+    return _df_memo_por_frame(df, "indice_filtros_etapa3", _v2_indice_filtros_calcular)
+
+
+def _v2_idx_mask_data(idx: dict, modo: str, d1, d2):
+    """Máscara de `_v2_aplicar_filtro_data_emissao` (None = sem restrição)."""
+    if not modo or "data" not in idx:
+        return None
+    dt = idx["data"]
+    t1 = pd.Timestamp(d1).normalize().to_datetime64() if d1 is not None else None
+    t2 = pd.Timestamp(d2).normalize().to_datetime64() if d2 is not None else None
+    if modo == ">=" and t1 is not None:
+        return dt >= t1
+    if modo == "<=" and t1 is not None:
+        return dt <= t1
+    if modo == "=" and t1 is not None:
+        return dt == t1
+    if modo == "entre" and t1 is not None and t2 is not None:
+        lo, hi = min(t1, t2), max(t1, t2)
+        return (dt >= lo) & (dt <= hi)
+    return None
+
+
+def _v2_idx_mask_faixa(idx: dict, modo: str, n1: int, n2: int):
+    """Máscara de `_v2_aplicar_filtro_faixa_nota` (None = sem restrição)."""
+    if not modo or "nota" not in idx:
+        return None
+    nn = idx["nota"]
+    if modo == ">=":
+        return nn >= n1
+    if modo == "<=":
+        return nn <= n1
+    if modo == "=":
+        return nn == n1
+    if modo == "entre":
+        lo, hi = min(n1, n2), max(n1, n2)
+        return (nn >= lo) & (nn <= hi)
+    return None
+
+
+def _v2_idx_restringir_nota_especifica(idx: dict, m: np.ndarray, chave_raw, numero_esp, serie_raw):
+    """`_v2_aplicar_nota_especifica_propria` sobre a máscara `m` (mesma precedência: chaves 44, INUT_, n.º+série)."""
+    if not m.any() or "Chave" not in idx["cols"]:
+        return m
+    ch_raw = str(chave_raw or "")
+    ch_st = ch_raw.strip()
+    chaves_44 = _v2_extrai_chaves_44_do_texto(ch_st)
+    ch_d_all = "".join(c for c in ch_st if c.isdigit())
+    if not chaves_44 and len(ch_d_all) >= 44:
+        chaves_44 = [ch_d_all[:44]]
+    if len(chaves_44) >= 1:
+        conj = set(chaves_44)
+        return m & _v2_idx_mask(idx, "Chave", lambda s: s.map(_chave_para_conjunto_export).isin(conj))
+
+    inuts = []
+    for line in ch_raw.splitlines():
+        lu = line.strip().upper()
+        if lu.startswith("INUT_") and len(lu) > 5:
+            inuts.append(lu)
+    inuts = list(dict.fromkeys(inuts))
+    if inuts:
+        sset = set(inuts)
+        return m & _v2_idx_mask(idx, "Chave", lambda s: s.astype(str).str.strip().str.upper().isin(sset))
+
+    try:
+        n = int(numero_esp)
+    except (TypeError, ValueError):
+        n = 0
+    ser = str(serie_raw or "").strip()
+    if ser and n > 0 and "nota" in idx and "Série" in idx["cols"]:
+        m_n = m & (idx["nota"] == n)
+        mask = m_n & _v2_idx_mask(idx, "Série", lambda s: s.astype(str).str.strip() == ser)
+        if not mask.any() and ser.isdigit():
+            mask = m_n & _v2_idx_mask(
+                idx, "Série", lambda s: pd.to_numeric(s.astype(str).str.strip(), errors="coerce") == int(ser)
+            )
+        return mask
+    return m
+
+
+def _v2_posicoes_filtro_exportacao(
+    df_base,
+    filtro_origem,
+    filtro_tipos,
+    filtro_series,
+    filtro_status_labels,
+    filtro_operacao_labels,
+    filtro_data_modo_label,
+    filtro_data_d1,
+    filtro_data_d2,
+    filtro_faixa_modo_label,
+    filtro_faixa_n1,
+    filtro_faixa_n2,
+    filtro_ufs,
+    nota_esp_chave="",
+    nota_esp_num=0,
+    nota_esp_serie="",
+    terceiros_status_labels=None,
+    terceiros_tipos=None,
+    terceiros_operacao_labels=None,
+    terceiros_data_modo_label="Qualquer",
+    terceiros_data_d1=None,
+    terceiros_data_d2=None,
+    *,
+    skip_filtro_serie=False,
+    skip_filtro_uf=False,
+    skip_nota_especifica=False,
+) -> np.ndarray:
+    """
+    Posições (iloc) em `df_base` das linhas de `filtrar_df_geral_para_exportacao`, na mesma ordem
+    (emissão própria e depois terceiros). Usa o índice por coluna do DataFrame e memoriza o resultado
+    por assinatura dos filtros (a mesma informação de `v2_assinatura_exportacao_sessao`).
+    """
+    idx = _v2_indice_filtros(df_base)
+    args = (
+        filtro_origem,
+        filtro_tipos,
+        filtro_series,
+        filtro_status_labels,
+        filtro_operacao_labels,
+        filtro_data_modo_label,
+        filtro_data_d1,
+        filtro_data_d2,
+        filtro_faixa_modo_label,
+        filtro_faixa_n1,
+        filtro_faixa_n2,
+        filtro_ufs,
+        nota_esp_chave,
+        nota_esp_num,
+        nota_esp_serie,
+        terceiros_status_labels,
+        terceiros_tipos,
+        terceiros_operacao_labels,
+        terceiros_data_modo_label,
+        terceiros_data_d1,
+        terceiros_data_d2,
+        skip_filtro_serie,
+        skip_filtro_uf,
+        skip_nota_especifica,
+    )
+    try:
+        sig = tuple(tuple(a) if isinstance(a, (list, tuple)) else a for a in args)
+        hash(sig)
+    except TypeError:
+        sig = None
+    memo = idx["posicoes"]
+    if sig is not None and sig in memo:
+        return memo[sig]
+
+    n = idx["n"]
+    todas = np.ones(n, dtype=bool)
+    if len(filtro_origem) > 0:
+        pat = "|".join([re.escape(o.split()[0]) for o in filtro_origem])
+        todas &= _v2_idx_mask(idx, "Origem", lambda s: s.str.contains(pat, regex=True, na=False))
+    m_p = todas & idx["propria"]
+    m_t = todas & ~idx["propria"]
+
+    st_vals = v2_status_labels_para_valores(filtro_status_labels)
+    if st_vals:
+        m_p &= _v2_idx_mask(idx, "Status Final", lambda s: s.isin(st_vals))
+    if len(filtro_tipos) > 0:
+        m_p &= _v2_idx_mask(idx, "Modelo", lambda s: s.isin(filtro_tipos))
+    op_int = v2_op_labels_para_interno(filtro_operacao_labels)
+    if op_int and "Operação" in idx["cols"]:
+        m_p &= _v2_idx_mask(idx, "Operação", lambda s: s.isin(op_int))
+    md = _v2_idx_mask_data(
+        idx, _v2_parse_modo_data(filtro_data_modo_label or "Qualquer"), filtro_data_d1, filtro_data_d2
+    )
+    if md is not None:
+        m_p &= md
+    if not skip_filtro_serie and len(filtro_series) > 0:
+        ser_set = {str(x) for x in filtro_series}
+        m_p &= _v2_idx_mask(idx, "Série", lambda s: s.astype(str).isin(ser_set))
+    modo_f = _v2_parse_modo_faixa(filtro_faixa_modo_label or "Qualquer")
+    if modo_f and len(filtro_series) > 0:
+        n1 = int(filtro_faixa_n1) if filtro_faixa_n1 is not None else 0
+        n2 = int(filtro_faixa_n2) if filtro_faixa_n2 is not None else n1
+        mf = _v2_idx_mask_faixa(idx, modo_f, n1, n2)
+        if mf is not None:
+            m_p &= mf
+    if not skip_filtro_uf and len(filtro_ufs) > 0 and "UF Destino" in idx["cols"]:
+        ufs = {str(u).strip().upper() for u in filtro_ufs}
+        m_p &= _v2_idx_mask(idx, "UF Destino", lambda s: s.astype(str).str.upper().isin(ufs))
+
+    st_t_vals = v2_status_labels_para_valores(list(terceiros_status_labels or []))
+    if st_t_vals:
+        m_t &= _v2_idx_mask(idx, "Status Final", lambda s: s.isin(st_t_vals))
+    _t_tip = list(terceiros_tipos or [])
+    if len(_t_tip) > 0:
+        m_t &= _v2_idx_mask(idx, "Modelo", lambda s: s.isin(_t_tip))
+    op_t_int = v2_op_labels_para_interno(list(terceiros_operacao_labels or []))
+    if op_t_int and "Operação" in idx["cols"]:
+        m_t &= _v2_idx_mask(idx, "Operação", lambda s: s.isin(op_t_int))
+    md_t = _v2_idx_mask_data(
+        idx, _v2_parse_modo_data(terceiros_data_modo_label or "Qualquer"), terceiros_data_d1, terceiros_data_d2
+    )
+    if md_t is not None:
+        m_t &= md_t
+
+    if not skip_nota_especifica:
+        m_p = _v2_idx_restringir_nota_especifica(idx, m_p, nota_esp_chave, nota_esp_num, nota_esp_serie)
+        m_t = _v2_idx_restringir_nota_especifica(idx, m_t, nota_esp_chave, nota_esp_num, nota_esp_serie)
+
+    pos = np.concatenate([np.flatnonzero(m_p), np.flatnonzero(m_t)])
+    pos.setflags(write=False)
+    if sig is not None:
+        while len(memo) >= _V2_IDX_MAX_POSICOES:
+            memo.pop(next(iter(memo)))
+        memo[sig] = pos
+    return pos
+
+
+def filtrar_df_geral_para_exportacao(
+    df_base,
+    filtro_origem,
+    filtro_tipos,
+    filtro_series,
+    filtro_status_labels,
+    filtro_operacao_labels,
+    filtro_data_modo_label,
+    filtro_data_d1,
+    filtro_data_d2,
+    filtro_faixa_modo_label,
+    filtro_faixa_n1,
+    filtro_faixa_n2,
+    filtro_ufs,
+    nota_esp_chave="",
+    nota_esp_num=0,
+    nota_esp_serie="",
+    terceiros_status_labels=None,
+    terceiros_tipos=None,
+    terceiros_operacao_labels=None,
+    terceiros_data_modo_label="Qualquer",
+    terceiros_data_d1=None,
+    terceiros_data_d2=None,
+    *,
+    skip_filtro_serie=False,
+    skip_filtro_uf=False,
+    skip_nota_especifica=False,
+):
+    """
+    filtro_origem: aplica-se a todas as linhas (própria e/ou terceiros), antes do resto.
+    Critérios v2_f_*: emissão própria.
+    Nota específica (chave(s) 44 dígitos, INUT_… ou n.º+série): própria e terceiros, como no Garimpeiro Raiz.
+    Critérios terceiros_*: só linhas de terceiros (XML recebidos).
+    """
+    if df_base is None or df_base.empty:
+        return df_base
+    pos = _v2_posicoes_filtro_exportacao(
+        df_base,
+        filtro_origem,
+        filtro_tipos,
+        filtro_series,
+        filtro_status_labels,
+        filtro_operacao_labels,
+        filtro_data_modo_label,
+        filtro_data_d1,
+        filtro_data_d2,
+        filtro_faixa_modo_label,
+        filtro_faixa_n1,
+        filtro_faixa_n2,
+        filtro_ufs,
+        nota_esp_chave,
+        nota_esp_num,
+        nota_esp_serie,
+        terceiros_status_labels,
+        terceiros_tipos,
+        terceiros_operacao_labels,
+        terceiros_data_modo_label,
+        terceiros_data_d1,
+        terceiros_data_d2,
+        skip_filtro_serie=skip_filtro_serie,
+        skip_filtro_uf=skip_filtro_uf,
+        skip_nota_especifica=skip_nota_especifica,
+    )
+    return df_base.iloc[pos].reset_index(drop=True)
+
+
+def _mask_terceiros_df(df: pd.DataFrame) -> pd.Series:
+    """Linhas cujo relatório indica documento recebido de terceiros."""
+    if df is None or df.empty or "Origem" not in df.columns:
+        return pd.Series(dtype=bool)
+    return df["Origem"].astype(str).str.contains("TERCEIROS", case=False, na=False)
+
+
+def _df_apenas_emissao_propria(df: pd.DataFrame) -> pd.DataFrame:
+    if df is None or not isinstance(df, pd.DataFrame) or df.empty:
+        return pd.DataFrame()
+    if "Origem" not in df.columns:
+        return df.reset_index(drop=True)
+    mp = _mask_emissao_propria_df(df)
+    mt = _mask_terceiros_df(df)
+    # Própria explícita, ou linhas sem etiqueta clara (não ficam só de fora dos dois lotes)
+    m = mp | (~mp & ~mt)
+    return df.loc[m].reset_index(drop=True)
+
+
+def _df_apenas_terceiros(df: pd.DataFrame) -> pd.DataFrame:
+    if df is None or not isinstance(df, pd.DataFrame) or df.empty:
+        return pd.DataFrame()
+    if "Origem" not in df.columns:
+        return pd.DataFrame()
+    mt = _mask_terceiros_df(df)
+    return df.loc[mt].reset_index(drop=True)
+
+
+def _folhas_detalhe_terceiros_do_subset(df: pd.DataFrame) -> dict:
+    """
+    Folhas do livro Excel alinhadas ao painel «terceiros»: canceladas, autorizadas,
+    denegadas e rejeitadas a partir de linhas TERCEIROS. Buracos e inutilizadas
+    não se aplicam a XML recebido de terceiros — df_bur e df_inu ficam sempre vazios.
+    """
+    empty = pd.DataFrame()
+    if df is None or not isinstance(df, pd.DataFrame) or df.empty:
+        return {
+            "df_bur": empty,
+            "df_inu": empty,
+            "df_can": empty,
+            "df_aut": empty,
+            "df_den": empty,
+            "df_rej": empty,
+        }
+    df_t = df.loc[_mask_terceiros_df(df)].copy()
+    if df_t.empty or "Status Final" not in df_t.columns:
+        return {
+            "df_bur": empty,
+            "df_inu": empty,
+            "df_can": empty,
+            "df_aut": empty,
+            "df_den": empty,
+            "df_rej": empty,
+        }
+    stu = df_t["Status Final"].astype(str).str.upper()
+    return {
+        "df_bur": empty,
+        "df_inu": empty,
+        "df_can": df_t.loc[stu.eq("CANCELADOS")].reset_index(drop=True),
+        "df_aut": df_t.loc[stu.eq("NORMAIS")].reset_index(drop=True),
+        "df_den": df_t.loc[stu.eq("DENEGADOS")].reset_index(drop=True),
+        "df_rej": df_t.loc[stu.eq("REJEITADOS")].reset_index(drop=True),
+    }
+
+
+def _v2_limpar_zips_gerados_etapa3(output_dir=None):
+    """Política: não apagar ZIP já gravados no disco — só gravar novos por cima se o nome repetir."""
+    return
+
+
+def _v2_excel_bytes_filtrado_etapa3(df: pd.DataFrame):
+    """Um .xlsx com folhas Filtrado e Resumo_status (igual ao ramo excel_filtro da Etapa 3)."""
+    if df is None or df.empty:
+        return None
+    buffer_excel = io.BytesIO()
+    with pd.ExcelWriter(buffer_excel, engine="xlsxwriter") as writer:
+        _df_xls_f = _df_com_data_emissao_dd_mm_yyyy(df.reset_index(drop=True))
+        _df_xls_f.to_excel(writer, sheet_name="Filtrado", index=False)
+        rs = (
+            _df_xls_f.groupby("Status Final", dropna=False)
+            .size()
+            .reset_index(name="Quantidade")
+        )
+        rs.to_excel(writer, sheet_name="Resumo_status", index=False)
+    return buffer_excel.getvalue()
+
+
+def excel_bytes_relatorio_bloco(df_filtrado: pd.DataFrame, chaves_bloco: set):
+    """Bytes de um .xlsx só com as linhas cujas Chave aparecem no bloco de XML (máx. 10k ficheiros)."""
+    if df_filtrado is None or df_filtrado.empty or not chaves_bloco:
+        return None
+    if "Chave" not in df_filtrado.columns:
+        return None
+    _norm = df_filtrado["Chave"].map(_chave_para_conjunto_export)
+    dfp = df_filtrado.loc[_norm.isin(chaves_bloco)]
+    if dfp.empty:
+        return None
+    dfp = _df_com_data_emissao_dd_mm_yyyy(dfp.reset_index(drop=True))
+    buf = io.BytesIO()
+    with pd.ExcelWriter(buf, engine="xlsxwriter") as writer:
+        dfp.to_excel(writer, sheet_name="Filtrado", index=False)
+        rs = (
+            dfp.groupby("Status Final", dropna=False)
+            .size()
+            .reset_index(name="Quantidade")
+        )
+        rs.to_excel(writer, sheet_name="Resumo_status", index=False)
+    return buf.getvalue()
+
+
+def _excel_bytes_pacote_contabilidade(
+    df_todas_lidas: pd.DataFrame, df_xml_pacote: pd.DataFrame
+):
+    """
+    Excel para envio à contabilidade: folha «Todas_lidas» + resumo; se df_xml_pacote for outro
+    DataFrame (não o mesmo objeto que df_todas_lidas), acrescenta XML_neste_pacote e resumo.
+    Folhas com datas em dd/mm/aaaa.
+    Devolve bytes ou None se falhar por disco/temp cheio (errno 28).
+    """
+    has_t = df_todas_lidas is not None and not df_todas_lidas.empty
+    has_x = df_xml_pacote is not None and not df_xml_pacote.empty
+    mesmo_lote = has_t and has_x and (df_xml_pacote is df_todas_lidas)
+    if not has_t and not has_x:
+        try:
+            buf0 = io.BytesIO()
+            with pd.ExcelWriter(buf0, engine="xlsxwriter") as w0:
+                pd.DataFrame({"Info": ["Sem linhas para exportar no Excel do pacote."]}).to_excel(
+                    w0, sheet_name="Aviso", index=False
+                )
+            return buf0.getvalue()
+        except Exception as e:
+            if _erro_sem_espaco_disco(e):
+                return None
+            raise
+    try:
+        buf = io.BytesIO()
+        with pd.ExcelWriter(buf, engine="xlsxwriter") as writer:
+            if has_t:
+                d1 = _df_com_data_emissao_dd_mm_yyyy(df_todas_lidas.reset_index(drop=True))
+                d1.to_excel(writer, sheet_name="Todas_lidas", index=False)
+                if "Status Final" in d1.columns:
+                    rs = (
+                        d1.groupby("Status Final", dropna=False)
+                        .size()
+                        .reset_index(name="Quantidade")
+                    )
+                    rs.to_excel(writer, sheet_name="Resumo_todas", index=False)
+            if has_x and not mesmo_lote:
+                d2 = _df_com_data_emissao_dd_mm_yyyy(df_xml_pacote.reset_index(drop=True))
+                d2.to_excel(writer, sheet_name="XML_neste_pacote", index=False)
+                if "Status Final" in d2.columns:
+                    r2 = (
+                        d2.groupby("Status Final", dropna=False)
+                        .size()
+                        .reset_index(name="Quantidade")
+                    )
+                    r2.to_excel(writer, sheet_name="Resumo_XML_pacote", index=False)
+        return buf.getvalue()
+    except Exception as e:
+        if _erro_sem_espaco_disco(e):
+            return None
+        raise
+
+
+def _excel_bytes_geral_e_resumo_status(df: pd.DataFrame) -> bytes:
+    """Um .xlsx com folhas Geral e Resumo_status (datas em dd/mm/aaaa)."""
+    buf = io.BytesIO()
+    _ddf = _df_com_data_emissao_dd_mm_yyyy(df.reset_index(drop=True))
+    with pd.ExcelWriter(buf, engine="xlsxwriter") as writer:
+        _ddf.to_excel(writer, sheet_name="Geral", index=False)
+        rs = (
+            _ddf.groupby("Status Final", dropna=False)
+            .size()
+            .reset_index(name="Quantidade")
+        )
+        rs.to_excel(writer, sheet_name="Resumo_status", index=False)
+    return buf.getvalue()
+
+
+def _v2_export_zip_etapa3(
+    df_g_base: pd.DataFrame,
+    *,
+    xml_respeita_filtro: bool,
+    df_filtrado_para_excel_bloco=None,
+    excel_um_so_completo: bool,
+    df_excel_completo: pd.DataFrame,
+    v2_zip_org: bool,
+    v2_zip_plano: bool,
+    cnpj_limpo: str,
+    zip_tag=None,
+    zip_output_dir=None,
+    zip_nome_ficheiro="",
+    pacote_pastas_garimpo: bool = False,
+    pacote_pastas_contabilidade: bool = False,
+    df_excel_todas_notas=None,
+):
+    """
+    Escreve ZIP(s) em disco (org / plano).
+    Devolve (org_parts, todos_parts, xml_matched, aviso_sem_xml|None, excel_pacote_matriz_solta|None).
+    xml_respeita_filtro=False â†’ todos os XML cujo resumo está em df_g_base.
+    excel_um_so_completo=True â†’ em cada parte, o mesmo Excel com df_excel_completo (relatório inteiro).
+    zip_tag: ex. «propria» / «terceiros» para nomes z_org_propria_pt1.zip (dois lotes independentes).
+    zip_output_dir: pasta onde gravar os .zip (None = diretório de trabalho atual).
+    zip_nome_ficheiro: opcional — base do nome (ex.: GarimpoMarco â†’ GarimpoMarco_org_propria_pt1.zip).
+    pacote_pastas_garimpo=True â†’ um ZIP só «com pastas»; stem = zip_nome_ficheiro ou pacote_apuracao_ptN.zip.
+    pacote_pastas_contabilidade=True â†’ ZIP por grupo `EP_AAAA_MM_Serie_…_Entrada|Saida_…_modelo` ou `T_AAAA_MM_…_modelo`; XML em XML/Lote_001…;
+    Excel na raiz do ZIP;
+    Excel em cada ZIP: mesmo conteúdo (todo o lido), nome `relatorio_garimpeiro_<grupo>.xlsx` (sem Painel Fiscal).
+    df_excel_todas_notas: DataFrame do relatório geral (df_geral) para a folha «Todas_lidas».
+    """
+    out_dir = (
+        Path(zip_output_dir).resolve()
+        if zip_output_dir is not None
+        else Path(".").resolve()
+    )
+    if pacote_pastas_garimpo:
+        u = _v2_sanitize_nome_export(zip_nome_ficheiro or "", max_len=80)
+        stem_org = u if u else "pacote_apuracao"
+        stem_todos = "z_todos_unused"
+    else:
+        stem_org, stem_todos = _v2_stems_zip_nome_ficheiro_etapa3(
+            zip_nome_ficheiro or "", zip_tag
+        )
+    if df_g_base is None or df_g_base.empty or "Chave" not in df_g_base.columns:
+        return [], [], 0, "ERR:Relatório geral vazio ou sem coluna Chave.", None
+    if xml_respeita_filtro:
+        if df_filtrado_para_excel_bloco is None or df_filtrado_para_excel_bloco.empty:
+            return [], [], 0, "ERR:Resultado filtrado: 0 linhas. Ajuste os filtros.", None
+        _df_ch = df_filtrado_para_excel_bloco
+    else:
+        _df_ch = df_g_base
+    filtro_chaves = {
+        k
+        for k in (_chave_para_conjunto_export(x) for x in _df_ch["Chave"].tolist())
+        if k
+    }
+    if not filtro_chaves:
+        return [], [], 0, "ERR:Nenhuma chave válida para exportar XML.", None
+
+    excel_fn_completo = (
+        _PACOTE_CONTAB_NOME_EXCEL_RAIZ
+        if pacote_pastas_contabilidade and excel_um_so_completo
+        else "RELATORIO_GARIMPEIRO/relatorio_geral_completo.xlsx"
+    )
+
+    xb_completo = None
+    aviso_sem_espaco_excel = None
+    if excel_um_so_completo:
+        if pacote_pastas_contabilidade:
+            df_xml_plan = (
+                df_filtrado_para_excel_bloco
+                if xml_respeita_filtro
+                else df_g_base
+            )
+            df_todas = df_excel_todas_notas
+            if df_todas is None or getattr(df_todas, "empty", True):
+                df_todas = df_g_base
+            try:
+                xb_completo = excel_relatorio_geral_com_dashboard_cache(
+                    df_todas, incluir_painel_fiscal=False
+                )
+            except Exception as ex_dash:
+                if _erro_sem_espaco_disco(ex_dash):
+                    aviso_sem_espaco_excel = _msg_sem_espaco_disco_garimpeiro()
+                xb_completo = None
+            if not xb_completo:
+                xb_completo = _excel_bytes_pacote_contabilidade(df_todas, df_xml_plan)
+                if xb_completo is None and not aviso_sem_espaco_excel:
+                    aviso_sem_espaco_excel = _msg_sem_espaco_disco_garimpeiro()
+        else:
+            xb_completo = _excel_bytes_geral_e_resumo_status(df_excel_completo)
+
+    if pacote_pastas_contabilidade and v2_zip_org and not v2_zip_plano:
+        paths, empty, xm, av, xls = _v2_export_pacote_contab_por_dimensoes(
+            out_dir,
+            stem_org,
+            filtro_chaves,
+            cnpj_limpo,
+            xb_completo,
+            excel_fn_completo,
+            _df_ch,
+        )
+        _excel_fonte_descartar(xb_completo)
+        if aviso_sem_espaco_excel:
+            av = (
+                f"{aviso_sem_espaco_excel} {av}"
+                if av
+                else aviso_sem_espaco_excel
+            )
+        return paths, empty, xm, av, xls
+
+    Z = {
+        "z_org": None,
+        "z_todos": None,
+        "org_parts": [],
+        "todos_parts": [],
+        "org_count": 0,
+        "todos_count": 0,
+        "curr_org_part": 1,
+        "curr_todos_part": 1,
+        "chaves_bloco": set(),
+        "seq_bloco": 1,
+        "xml_matched": 0,
+    }
+
+    def _fechar_bloco_zip():
+        if excel_um_so_completo:
+            excel_fn = excel_fn_completo
+            xb = xb_completo
+        else:
+            excel_fn = f"RELATORIO_GARIMPEIRO/relatorio_filtrado_pt{Z['seq_bloco']:03d}.xlsx"
+            xb = excel_bytes_relatorio_bloco(
+                df_filtrado_para_excel_bloco, Z["chaves_bloco"]
+            )
+        if xb:
+            if v2_zip_org and Z["z_org"] is not None:
+                _zip_escrever_excel(Z["z_org"], excel_fn, xb)
+            if v2_zip_plano and Z["z_todos"] is not None:
+                _zip_escrever_excel(Z["z_todos"], excel_fn, xb)
+        Z["chaves_bloco"].clear()
+        Z["seq_bloco"] += 1
+        if (
+            v2_zip_org
+            and Z["z_org"] is not None
+            and Z["org_count"] >= MAX_XML_PER_ZIP
+        ):
+            try:
+                Z["z_org"].close()
+            except OSError:
+                pass
+            Z["curr_org_part"] += 1
+            oname = str(out_dir / f"{stem_org}_pt{Z['curr_org_part']}.zip")
+            Z["z_org"] = _zipfile_open_write_export(oname)
+            Z["org_parts"].append(oname)
+            Z["org_count"] = 0
+        if (
+            v2_zip_plano
+            and Z["z_todos"] is not None
+            and Z["todos_count"] >= MAX_XML_PER_ZIP
+        ):
+            try:
+                Z["z_todos"].close()
+            except OSError:
+                pass
+            Z["curr_todos_part"] += 1
+            tname = str(out_dir / f"{stem_todos}_pt{Z['curr_todos_part']}.zip")
+            Z["z_todos"] = _zipfile_open_write_export(tname)
+            Z["todos_parts"].append(tname)
+            Z["todos_count"] = 0
+
+    if v2_zip_org:
+        org_name = str(out_dir / f"{stem_org}_pt{Z['curr_org_part']}.zip")
+        Z["z_org"] = _zipfile_open_write_export(org_name)
+        Z["org_parts"].append(org_name)
+    if v2_zip_plano:
+        todos_name = str(out_dir / f"{stem_todos}_pt{Z['curr_todos_part']}.zip")
+        Z["z_todos"] = _zipfile_open_write_export(todos_name)
+        Z["todos_parts"].append(todos_name)
+
+    if v2_zip_org or v2_zip_plano:
+        chaves_ja_org = set()
+        chaves_ja_todos = set()
+        for name, xml_data, res, is_p, bruto in _garimpo_iter_xml_lote(
+            cnpj_limpo,
+            lambda r, _p: _chave_para_conjunto_export(r.get("Chave")) in filtro_chaves,
+            bruto=True,
+        ):
+            ck = _chave_para_conjunto_export(res["Chave"])
+            if ck and ck in filtro_chaves:
+                td = _tupla_dedupe_export_xml(res, ck)
+                if td is None:
+                    del xml_data
+                    continue
+                org_ok = (
+                    v2_zip_org
+                    and Z["z_org"] is not None
+                    and td not in chaves_ja_org
+                )
+                todos_ok = (
+                    v2_zip_plano
+                    and Z["z_todos"] is not None
+                    and td not in chaves_ja_todos
+                )
+                if not org_ok and not todos_ok:
+                    del xml_data
+                    continue
+                if org_ok:
+                    chaves_ja_org.add(td)
+                    if pacote_pastas_contabilidade:
+                        inner = _caminho_xml_pacote_contab_raiz(res, name)
+                    else:
+                        inner = f"{res['Pasta']}/{name}"
+                    _zip_gravar_membro(Z["z_org"], inner, xml_data, bruto)
+                    Z["org_count"] += 1
+                if todos_ok:
+                    chaves_ja_todos.add(td)
+                    _zip_gravar_membro(Z["z_todos"], name, xml_data, bruto)
+                    Z["todos_count"] += 1
+                Z["xml_matched"] += int(org_ok) + int(todos_ok)
+                Z["chaves_bloco"].add(ck)
+                limite = (
+                    v2_zip_org and Z["org_count"] >= MAX_XML_PER_ZIP
+                ) or (v2_zip_plano and Z["todos_count"] >= MAX_XML_PER_ZIP)
+                if limite:
+                    _fechar_bloco_zip()
+            del xml_data
+
+    if Z["chaves_bloco"] and (
+        (v2_zip_org and Z["org_count"] > 0) or (v2_zip_plano and Z["todos_count"] > 0)
+    ):
+        excel_fn_last = (
+            excel_fn_completo
+            if excel_um_so_completo
+            else f"RELATORIO_GARIMPEIRO/relatorio_filtrado_pt{Z['seq_bloco']:03d}.xlsx"
+        )
+        if excel_um_so_completo:
+            xb_last = xb_completo
+        else:
+            xb_last = excel_bytes_relatorio_bloco(
+                df_filtrado_para_excel_bloco, Z["chaves_bloco"]
+            )
+        if xb_last:
+            if v2_zip_org and Z["z_org"] is not None and Z["org_count"] > 0:
+                _zip_escrever_excel(Z["z_org"], excel_fn_last, xb_last)
+            if v2_zip_plano and Z["z_todos"] is not None and Z["todos_count"] > 0:
+                _zip_escrever_excel(Z["z_todos"], excel_fn_last, xb_last)
+
+    if Z["z_org"] is not None:
+        try:
+            Z["z_org"].close()
+        except OSError:
+            pass
+    if Z["z_todos"] is not None:
+        try:
+            Z["z_todos"].close()
+        except OSError:
+            pass
+
+    _excel_fonte_descartar(xb_completo)
+    org_parts = Z["org_parts"]
+    todos_parts = Z["todos_parts"]
+    if v2_zip_org and Z["org_count"] == 0 and org_parts:
+        org_parts = []
+    if v2_zip_plano and Z["todos_count"] == 0 and todos_parts:
+        todos_parts = []
+
+    aviso = None
+    if (v2_zip_org or v2_zip_plano) and Z.get("xml_matched", 0) == 0:
+        aviso = (
+            "Nenhum XML em disco correspondeu às chaves. "
+            "Causas frequentes: pasta do garimpo apagada, ou chaves na tabela que não batem com os ficheiros."
+        )
+    return org_parts, todos_parts, Z["xml_matched"], aviso, None
+
+
+def _v2_export_zip_mariana(
+    df_geral: pd.DataFrame,
+    cnpj_limpo: str,
+    *,
+    zip_output_dir: Path,
+    zip_file_stem=None,
+):
+    """
+    Pacote contabilidade/matriz: **todo** o lote lido no garimpo (df_geral), **sem** filtros da Etapa 3.
+    ZIPs por grupo: **própria** `EP_ano_mes_Serie_…_Entrada|Saida_status_modelo`; **terceiros** `T_ano_mes_status_modelo`;
+    sufixo `_notas_min_max` nos .zip quando aplicável; dentro: `XML/Lote_001…` (10k/pasta) + Excel na raiz.
+    """
+    nome = str(zip_file_stem or "").strip()
+    o, _t, xm, av, xls = _v2_export_zip_etapa3(
+        df_geral,
+        xml_respeita_filtro=False,
+        df_filtrado_para_excel_bloco=df_geral,
+        excel_um_so_completo=True,
+        df_excel_completo=df_geral,
+        v2_zip_org=True,
+        v2_zip_plano=False,
+        cnpj_limpo=cnpj_limpo,
+        zip_tag=None,
+        zip_output_dir=zip_output_dir,
+        zip_nome_ficheiro=nome,
+        pacote_pastas_garimpo=True,
+        pacote_pastas_contabilidade=True,
+        df_excel_todas_notas=df_geral,
+    )
+    return o, xm, av, xls
+
+
+def _v2_uniq_sorted_str_series_vals(s: pd.Series) -> list:
+    return sorted(
+        {str(x) for x in s.tolist() if str(x) not in ("", "nan", "None")},
+        key=lambda x: (len(x), x),
+    )
+
+
+def v2_opcoes_cascata_etapa3(
+    df_base: pd.DataFrame,
+    filtro_origem: list,
+    filtro_tipos: list,
+    filtro_series: list,
+    filtro_status_labels: list,
+    filtro_operacao_labels: list,
+    filtro_data_modo_label: str,
+    filtro_data_d1,
+    filtro_data_d2,
+    filtro_faixa_modo_label: str,
+    filtro_faixa_n1: int,
+    filtro_faixa_n2: int,
+    filtro_ufs: list,
+    nota_esp_chave: str,
+    nota_esp_num: int,
+    nota_esp_serie: str,
+    terceiros_status_labels: list,
+    terceiros_tipos: list,
+    terceiros_operacao_labels: list,
+    terceiros_data_modo_label: str,
+    terceiros_data_d1,
+    terceiros_data_d2,
+) -> dict:
+    """Listas dependentes para Série e UF (só emissão própria), dados os outros filtros."""
+    empty = {"series": [], "ufs": []}
+    if df_base is None or df_base.empty:
+        return empty
+
+    filtros = (
+        filtro_origem,
+        filtro_tipos,
+        filtro_series,
+        filtro_status_labels,
+        filtro_operacao_labels,
+        filtro_data_modo_label,
+        filtro_data_d1,
+        filtro_data_d2,
+        filtro_faixa_modo_label,
+        filtro_faixa_n1,
+        filtro_faixa_n2,
+        filtro_ufs,
+        nota_esp_chave,
+        nota_esp_num,
+        nota_esp_serie,
+        terceiros_status_labels,
+        terceiros_tipos,
+        terceiros_operacao_labels,
+        terceiros_data_modo_label,
+        terceiros_data_d1,
+        terceiros_data_d2,
+    )
+    # Sem cópias: posições das linhas filtradas → valores distintos (códigos do índice) só da emissão própria.
+    idx = _v2_indice_filtros(df_base)
+
+    def _distintos_em_propria(col, pos):
+        if col not in idx["cols"]:
+            return None
+        codigos, distintos = idx["cols"][col]
+        pos = pos[idx["propria"][pos]]
+        return distintos.iloc[np.unique(codigos[pos])]
+
+    p_ser = _v2_posicoes_filtro_exportacao(
+        df_base, *filtros, skip_filtro_serie=True, skip_filtro_uf=False, skip_nota_especifica=True
+    )
+    p_uf = _v2_posicoes_filtro_exportacao(
+        df_base, *filtros, skip_filtro_serie=False, skip_filtro_uf=True, skip_nota_especifica=True
+    )
+    d_ser = _distintos_em_propria("Série", p_ser)
+    d_uf = _distintos_em_propria("UF Destino", p_uf)
+    ufs = []
+    if d_uf is not None:
+        ser = d_uf.astype(str).str.upper().str.strip()
+        ufs = sorted({x for x in ser.tolist() if x and x not in ("NAN", "NONE", "")})
+    return {
+        "series": _v2_uniq_sorted_str_series_vals(d_ser.astype(str)) if d_ser is not None else [],
+        "ufs": ufs,
+    }
+
+
+def v2_sanear_selecoes_contra_opcoes(series_opts: list, ufs_opts: list) -> None:
+    """Remove da sessão valores que deixaram de existir nas listas em cascata (série / UF)."""
+    for key, permitidos in (
+        ("v2_f_ser", set(series_opts)),
+        ("v2_f_uf", set(ufs_opts)),
+    ):
+        cur = list(st.session_state.get(key) or [])
+        novo = [x for x in cur if x in permitidos]
+        if novo != cur:
+            st.session_state[key] = novo
+
+
+def _v2_remover_zips_em_disco_listados():
+    """Política: nunca apagar ficheiros exportados que o utilizador guardou em pasta."""
+    return
+
+
+def _v2_limpar_estado_exportacao_etapa3(remover_zip_do_disco=True):
+    """
+    Reinicia sessão de downloads da Etapa 3.
+    Os ZIP no disco do utilizador **não são apagados** (política: só gravar).
+    remover_zip_do_disco mantido por compatibilidade; a remoção em disco está desativada.
+    """
+    if remover_zip_do_disco:
+        _v2_remover_zips_em_disco_listados()
+    st.session_state["export_ready"] = False
+    st.session_state["org_zip_parts"] = []
+    st.session_state["todos_zip_parts"] = []
+    st.session_state["excel_buffer"] = None
+    st.session_state.pop("excel_buffer_propria", None)
+    st.session_state.pop("excel_buffer_terceiros", None)
+    st.session_state.pop("export_excel_name_propria", None)
+    st.session_state.pop("export_excel_name_terceiros", None)
+    st.session_state.pop("v2_export_sig", None)
+    st.session_state.pop("v2_export_sem_xml", None)
+    st.session_state["v2_etapa3_dual_export"] = False
+    st.session_state.pop("v2_export_lados", None)
+    st.session_state.pop("mariana_zip_parts", None)
+    st.session_state["mariana_export_ready"] = False
+    st.session_state.pop("mariana_export_sig", None)
+    st.session_state.pop("mariana_sem_xml_msg", None)
+    st.session_state.pop("mariana_excel_completo_path", None)
+
+
+def v2_assinatura_exportacao_sessao():
+    """
+    Identifica filtros + confirmação «exportar tudo» + formato (ZIP/Excel).
+    Se mudar após uma geração, os downloads guardados deixam de ser válidos.
+    """
+    return (
+        tuple(st.session_state.get("v2_f_orig") or []),
+        tuple(st.session_state.get("v2_f_tip") or []),
+        tuple(st.session_state.get("v2_f_ser") or []),
+        tuple(st.session_state.get("v2_f_stat") or []),
+        tuple(st.session_state.get("v2_f_op") or []),
+        tuple(st.session_state.get("v2_f_uf") or []),
+        str(st.session_state.get("v2_f_data_modo", "Qualquer")),
+        str(st.session_state.get("v2_f_data_d1", "")),
+        str(st.session_state.get("v2_f_data_d2", "")),
+        str(st.session_state.get("v2_f_faixa_modo", "Qualquer")),
+        int(st.session_state.get("v2_f_faixa_n1") or 0),
+        int(st.session_state.get("v2_f_faixa_n2") or 0),
+        str(st.session_state.get("v2_f_esp_chave", "")),
+        int(st.session_state.get("v2_f_esp_num") or 0),
+        str(st.session_state.get("v2_f_esp_ser", "")),
+        tuple(st.session_state.get("v2_t_stat") or []),
+        tuple(st.session_state.get("v2_t_tip") or []),
+        tuple(st.session_state.get("v2_t_op") or []),
+        str(st.session_state.get("v2_t_data_modo", "Qualquer")),
+        str(st.session_state.get("v2_t_data_d1", "")),
+        str(st.session_state.get("v2_t_data_d2", "")),
+        bool(st.session_state.get("v2_confirm_full", True)),
+        str(st.session_state.get("v2_export_format", "zip_tudo_pastas")),
+    )
 
-    _MAX_FAIXA_CANC = 5000
-    n_f_c = 0
-    err_f_c = None
-    df_fbc = st.session_state["df_faltantes"].copy()
-    if not df_fbc.empty and "Serie" in df_fbc.columns and "Série" not in df_fbc.columns:
-        df_fbc = df_fbc.rename(columns={"Serie": "Série"})
-    _bur_fc = set()
-    _mfc = mf_canc_f if mf_canc_f is not None else "NF-e"
-    _sfc = (sf_canc_f if sf_canc_f is not None else "1") or "1"
-    _n0c = int(n0_canc_f if n0_canc_f is not None else 1)
-    _n1c = int(n1_canc_f if n1_canc_f is not None else 1)
-    if (
-        not df_fbc.empty
-        and {"Tipo", "Série", "Num_Faltante"}.issubset(df_fbc.columns)
-    ):
-        _subfc = df_fbc[
-            (df_fbc["Tipo"].astype(str) == _mfc)
-            & (df_fbc["Série"].astype(str) == str(_sfc).strip())
-        ]
-        _bur_fc = set(_subfc["Num_Faltante"].astype(int).unique())
-    if not str(_sfc).strip():
-        pass
-    elif _n0c > _n1c:
-        err_f_c = "Canceladas — faixa: a nota inicial não pode ser maior que a final."
-    elif (_n1c - _n0c + 1) > _MAX_FAIXA_CANC:
-        err_f_c = f"Canceladas — faixa: máximo {_MAX_FAIXA_CANC} notas."
-    elif not _bur_fc:
-        err_f_c = "Canceladas — faixa: não há buracos para este modelo/série."
-    else:
-        _aplic_fc = [n for n in range(int(_n0c), int(_n1c) + 1) if n in _bur_fc]
-        if _aplic_fc:
-            for _nn in _aplic_fc:
-                _itfc = item_registro_manual_cancelado(cnpj_limpo, _mfc, str(_sfc).strip(), _nn)
-                if not _relatorio_ja_tem_chave(_itfc["Chave"]) and not _registro_manual_cancel_duplicada(
-                    st.session_state["relatorio"], _mfc, str(_sfc).strip(), _nn
-                ):
-                    st.session_state["relatorio"].append(_itfc)
-                    n_f_c += 1
-            if n_f_c:
-                linhas.append(f"**{n_f_c}** nota(s) da faixa de **canceladas** (buracos).")
 
-    tem_ficheiros = _garimpo_existem_fontes_xml_lote()
-    fez_algo = (
-        n_extra > 0
-        or n_b > 0
-        or n_p > 0
-        or n_f > 0
-        or n_b_c > 0
-        or n_p_c > 0
-        or n_f_c > 0
+def v2_assinatura_pacote_matriz_sessao(df_geral):
+    """
+    Pacote contabilidade / matriz: **não** inclui filtros da Etapa 3.
+    Invalida ao mudar o relatório geral (novo garimpo), pasta/nome do ZIP ou CNPJ na sessão.
+    """
+    return (
+        id(df_geral) if df_geral is not None else 0,
+        str(st.session_state.get("mariana_zip_save_dir") or ""),
+        str(st.session_state.get("mariana_zip_basename") or ""),
+        str(st.session_state.get("cnpj_widget") or ""),
     )
-    quer_compare_autent = _tem_upload_autenticidade(up_autent_sefaz)
 
-    if err_p:
-        return False, err_p, linhas
-    if err_p_c:
-        return False, err_p_c, linhas
-    if (err_f or err_f_c) and not fez_algo and not tem_ficheiros and not quer_compare_autent:
-        _msg_ff = err_f or err_f_c
-        return False, _msg_ff, linhas
-    if err_f:
-        linhas.append(f"Aviso (faixa inutil.): {err_f}")
-    if err_f_c:
-        linhas.append(f"Aviso (faixa cancel.): {err_f_c}")
 
-    if not fez_algo and not tem_ficheiros and not quer_compare_autent:
+def v2_callback_repor_filtros():
+    """Limpa multiselects da Etapa 3. Deve ser usado com on_click (antes dos widgets na mesma corrida)."""
+    for _kx in (
+        "v2_f_orig",
+        "v2_f_tip",
+        "v2_f_ser",
+        "v2_f_stat",
+        "v2_f_op",
+        "v2_f_uf",
+        "v2_t_stat",
+        "v2_t_tip",
+        "v2_t_op",
+    ):
+        st.session_state[_kx] = []
+    st.session_state["v2_f_data_modo"] = "Qualquer"
+    st.session_state["v2_f_faixa_modo"] = "Qualquer"
+    st.session_state["v2_f_faixa_n1"] = 0
+    st.session_state["v2_f_faixa_n2"] = 0
+    st.session_state.pop("v2_f_data_d1", None)
+    st.session_state.pop("v2_f_data_d2", None)
+    st.session_state["v2_f_esp_chave"] = ""
+    st.session_state["v2_f_esp_num"] = 0
+    st.session_state["v2_f_esp_ser"] = ""
+    st.session_state["v2_t_data_modo"] = "Qualquer"
+    st.session_state.pop("v2_t_data_d1", None)
+    st.session_state.pop("v2_t_data_d2", None)
+    st.session_state["v2_export_format"] = "zip_tudo_pastas"
+    _v2_limpar_estado_exportacao_etapa3()
+    st.session_state.pop("_v2_e3_preview_dis_cache", None)
+
+
+def rotulo_download_zip_parte(caminho_ficheiro):
+    base = os.path.basename(caminho_ficheiro)
+    m = re.search(r"pt(\d+)\.zip$", base, re.I)
+    if m:
+        return f"ZIP — parte {m.group(1)}"
+    if "__" in base and base.lower().endswith(".zip"):
+        return base[:-4].split("__", 1)[-1]
+    if base.lower().endswith(".zip"):
+        return base[:-4]
+    return base
+
+
+_st_download_diferido_memo = []
+
+
+def _st_download_diferido_suportado() -> bool:
+    """True se esta versão do Streamlit aceita uma função em `download_button(data=...)` (lida só no clique)."""
+    if not _st_download_diferido_memo:
+        try:
+            from streamlit.runtime.media_file_manager import MediaFileManager
+
+            _st_download_diferido_memo.append(hasattr(MediaFileManager, "add_deferred"))
+        except Exception:
+            _st_download_diferido_memo.append(False)
+    return _st_download_diferido_memo[0]
+
+
+def _st_download_ler_ficheiro(caminho, regenerar=None):
+    """
+    Função sem argumentos que lê `caminho` quando o utilizador carrega no botão. Se entretanto o ficheiro saiu
+    da cache / do spool, `regenerar()` (sem sessão: corre na thread do servidor) devolve outro caminho ou bytes;
+    sem isso (ou se falhar) a descarga é um .txt curto a explicar que é preciso gerar de novo — o Streamlit não
+    tem como mostrar um erro nesse clique.
+    """
+
+    def _ler():
+        _artefacto_tocar(caminho)
+        try:
+            with open(caminho, "rb") as fh:
+                return fh.read()
+        except FileNotFoundError:
+            pass
+        if regenerar is not None:
+            try:
+                novo = regenerar()
+                if novo:
+                    return _excel_ficheiro_para_bytes(novo) if _excel_fonte_e_ficheiro(novo) else novo
+            except Exception:
+                pass
         return (
-            False,
-            "Nada a processar: inclua XML/ZIP, inutilizações / canceladas manuais, "
-            "o **relatório de autenticidade** (Sefaz) ou faça o garimpo para haver ficheiros em disco.",
-            linhas,
-        )
+            f"O ficheiro «{os.path.basename(caminho)}» já não está disponível no servidor "
+            "(limpeza da cache ou da pasta temporária).\r\n"
+            "Volte à aplicação e gere-o de novo.\r\n"
+        ).encode("utf-8")
 
-    if not quer_compare_autent and (fez_algo or tem_ficheiros):
-        st.session_state.pop("df_divergencias", None)
-        st.session_state["validation_done"] = False
+    return _ler
 
-    st.session_state["export_ready"] = False
-    st.session_state["excel_buffer"] = None
 
-    if tem_ficheiros:
-        if len(cnpj) != 14:
-            return False, "CNPJ inválido na barra lateral — necessário para reler os XML.", linhas
-        ok, msg_rep = reprocessar_garimpeiro_a_partir_do_disco(
-            cnpj_limpo, footer_ph=footer_ph, t_start=t_start
+def _st_download_ficheiro(rotulo, fonte, *, key, file_name=None, mime=None, alvo=None, regenerar=None):
+    """
+    `st.download_button` para um ficheiro já gravado (partes ZIP, Excel/PDF da cache de relatórios) sem o ler
+    a cada rerun: o Streamlit só abre o ficheiro no clique. Em versões sem descarga diferida mostra antes um
+    botão «Preparar» e só essa parte é lida. Bytes e temporários de `_excel_pasta_temp` (apagados ao ler) vão
+    directos, como antes. `alvo` é o contentor (coluna, sidebar); por omissão `st`. `regenerar`: ver
+    `_st_download_ler_ficheiro`. Se o ficheiro já não existe, fica um aviso no lugar do botão.
+    """
+    alvo = st if alvo is None else alvo
+    if not fonte:
+        return False
+    if not _excel_fonte_e_ficheiro(fonte) or _excel_fonte_e_temporaria(fonte):
+        dados = _excel_ficheiro_para_bytes(fonte) if _excel_fonte_e_ficheiro(fonte) else fonte
+        if not dados:
+            return False
+        return alvo.download_button(rotulo, dados, file_name=file_name, mime=mime, key=key)
+    caminho = os.fspath(fonte)
+    if not os.path.isfile(caminho):
+        alvo.caption(f"«{rotulo}» já não está disponível no servidor — gere de novo.")
+        return False
+    _artefacto_tocar(caminho)
+    file_name = file_name or os.path.basename(caminho)
+    if _st_download_diferido_suportado():
+        return alvo.download_button(
+            rotulo, _st_download_ler_ficheiro(caminho, regenerar), file_name=file_name, mime=mime, key=key
         )
-        if not ok:
-            return False, msg_rep, linhas
-        linhas.append(msg_rep)
-        if quer_compare_autent:
-            ok_a, msg_a = _aplicar_comparacao_autenticidade(up_autent_sefaz)
-            if not ok_a:
-                return False, msg_a, linhas
-            linhas.append(msg_a)
-        return True, "\n\n".join(linhas), linhas
+    k_pronto = f"{key}__pronto"
+    if st.session_state.get(k_pronto) != caminho:
+        if alvo.button(f"Preparar · {rotulo}", key=f"{key}__preparar"):
+            st.session_state[k_pronto] = caminho
+        else:
+            return False
+    try:
+        with open(caminho, "rb") as fh:
+            dados = fh.read()
+    except FileNotFoundError:
+        dados = _st_download_ler_ficheiro(caminho, regenerar)()
+    except OSError:
+        st.session_state.pop(k_pronto, None)
+        return False
+    return alvo.download_button(rotulo, dados, file_name=file_name, mime=mime, key=key)
 
-    reconstruir_dataframes_relatorio_simples()
-    linhas.append(
-        "Relatório recalculado (sem ficheiros na pasta de uploads — só registos manuais de inutil. / cancel.)."
-    )
-    if quer_compare_autent:
-        ok_a, msg_a = _aplicar_comparacao_autenticidade(up_autent_sefaz)
-        if not ok_a:
-            return False, msg_a, linhas
-        linhas.append(msg_a)
-    return True, "\n\n".join(linhas), linhas
 
+def enumerar_buracos_por_segmento(nums_sorted, tipo_doc, serie_str, gap_max=MAX_SALTO_ENTRE_NOTAS_CONSECUTIVAS):
+    """Buracos só dentro de cada trecho; saltos grandes quebram o trecho (não preenche o intervalo entre faixas)."""
+    if not len(nums_sorted):
+        return []
+    faixas = _buraco_faixas_lacunas(_buraco_faixas_de_numeros(_buraco_np_unicos(nums_sorted)), gap_max)
+    return [
+        {"Tipo": tipo_doc, "Série": serie_str, "Num_Faltante": b}
+        for b in _buraco_faixas_expandir(faixas).tolist()
+    ]
 
-_V2_STATUS_UI_PARA_DF = {
-    "Autorizadas": ["NORMAIS"],
-    "Canceladas": ["CANCELADOS"],
-    "Inutilizadas": ["INUTILIZADOS", "INUTILIZADA"],
-    "Denegadas": ["DENEGADOS"],
-    "Rejeitadas": ["REJEITADOS"],
-}
-_V2_OP_UI_PARA_INTERNO = {"Entrada": "ENTRADA", "Saída": "SAIDA"}
-_V2_DATA_MODELO_LABELS = ("Qualquer", "Maior ou igual a", "Menor ou igual a", "Igual a", "Entre")
-_V2_FAIXA_MODELO_LABELS = _V2_DATA_MODELO_LABELS
 
+_CHAVE_44_RE = re.compile(r"\d{44}")
 
-def v2_status_labels_para_valores(labels):
+
+def _celula_extra_chaves_acesso_44(val):
+    """Extrai uma ou mais sequências de 44 dígitos de uma célula (texto ou número)."""
     out = []
-    for L in labels or []:
-        out.extend(_V2_STATUS_UI_PARA_DF.get(L, []))
-    return list(dict.fromkeys(out))
+    if val is None or (isinstance(val, float) and pd.isna(val)):
+        return out
+    if isinstance(val, (int, float)) and not isinstance(val, bool):
+        try:
+            f = float(val)
+            s = str(int(f)) if f.is_integer() else str(val).strip()
+        except (ValueError, OverflowError):
+            s = str(val).strip()
+    else:
+        s = str(val).strip()
+    if not s:
+        return out
+    out.extend(_CHAVE_44_RE.findall(s))
+    digitos = "".join(filter(str.isdigit, s))
+    if len(digitos) >= 44:
+        bl = digitos[:44]
+        if bl not in out:
+            out.append(bl)
+    return out
+
+
+def _scan_dataframe_chaves_44(df: pd.DataFrame) -> list:
+    """Percorre colunas; prioriza cabeçalhos com «chave» / «acesso»."""
+    if df is None or df.empty:
+        return []
+    cols = list(df.columns)
+    pref = []
+    for c in cols:
+        cn = str(c).strip().lower().replace("_", " ")
+        if "chave" in cn.replace(" ", "") or "acesso" in cn or cn == "key":
+            pref.append(c)
+    ordem = pref + [c for c in cols if c not in pref]
+    chaves_ord = []
+    seen = set()
+    for c in ordem:
+        for val in df[c]:
+            for ch in _celula_extra_chaves_acesso_44(val):
+                if ch not in seen:
+                    seen.add(ch)
+                    chaves_ord.append(ch)
+    return chaves_ord
+
+
+def extrair_chaves_de_planilha(arquivo_upload):
+    """
+    Lê Excel (.xlsx, .xls) ou CSV com chaves de 44 dígitos.
+    Procura coluna «Chave» (ou equivalente) e, em qualquer caso, todas as células.
+    Tenta 1.ª linha como cabeçalho; se não encontrar chaves, tenta sem cabeçalho.
+    """
+    if arquivo_upload is None:
+        return []
+    raw = arquivo_upload.read()
+    try:
+        arquivo_upload.seek(0)
+    except Exception:
+        pass
+    nome = (getattr(arquivo_upload, "name", "") or "").lower()
 
+    def read_df(header):
+        if nome.endswith(".csv"):
+            for enc in ("utf-8-sig", "utf-8", "cp1252", "latin-1"):
+                try:
+                    return pd.read_csv(
+                        io.BytesIO(raw),
+                        sep=None,
+                        engine="python",
+                        encoding=enc,
+                        header=header,
+                    )
+                except Exception:
+                    continue
+            return None
+        try:
+            return pd.read_excel(io.BytesIO(raw), header=header)
+        except Exception:
+            return None
 
-def v2_op_labels_para_interno(labels):
-    return [_V2_OP_UI_PARA_INTERNO[x] for x in (labels or []) if x in _V2_OP_UI_PARA_INTERNO]
+    for header in (0, None):
+        df = read_df(header)
+        if df is None or df.empty:
+            continue
+        keys = _scan_dataframe_chaves_44(df)
+        if keys:
+            return keys
+    return []
 
 
-def _mask_emissao_propria_df(df: pd.DataFrame) -> pd.Series:
-    if df is None or df.empty or "Origem" not in df.columns:
-        return pd.Series(dtype=bool)
-    o = df["Origem"].astype(str)
-    return o.str.contains("PRÓPRIA|PROPRIA", case=False, na=False, regex=True)
+def extrair_chaves_de_excel(arquivo_excel):
+    """Nome legado — mesmo que extrair_chaves_de_planilha."""
+    return extrair_chaves_de_planilha(arquivo_excel)
 
 
-def _v2_parse_modo_data(label: str) -> str:
-    return {
-        "Qualquer": "",
-        "Maior ou igual a": ">=",
-        "Menor ou igual a": "<=",
-        "Igual a": "=",
-        "Entre": "entre",
-    }.get(label or "", "")
+_MAX_FAIXA_EXPORT_DOM = 5000  # Máx. largura de faixa por linha (lista específica / inutilizadas)
 
 
-def _v2_parse_modo_faixa(label: str) -> str:
-    return _v2_parse_modo_data(label)
+def _excel_celula_int(val):
+    if val is None or (isinstance(val, float) and pd.isna(val)):
+        return None
+    if isinstance(val, str):
+        s = val.strip()
+        if not s:
+            return None
+        try:
+            return int(float(s.replace(",", ".")))
+        except ValueError:
+            return None
+    try:
+        return int(float(val))
+    except (TypeError, ValueError):
+        return None
 
 
-def _v2_aplicar_filtro_data_emissao(df_p: pd.DataFrame, modo: str, d1, d2) -> pd.DataFrame:
-    if df_p.empty or not modo or "Data Emissão" not in df_p.columns:
-        return df_p
-    dt = pd.to_datetime(df_p["Data Emissão"], errors="coerce").dt.normalize()
-    if d1 is not None:
-        t1 = pd.Timestamp(d1).normalize()
-    else:
-        t1 = None
-    if d2 is not None:
-        t2 = pd.Timestamp(d2).normalize()
-    else:
-        t2 = None
-    if modo == ">=" and t1 is not None:
-        return df_p.loc[dt >= t1]
-    if modo == "<=" and t1 is not None:
-        return df_p.loc[dt <= t1]
-    if modo == "=" and t1 is not None:
-        return df_p.loc[dt == t1]
-    if modo == "entre" and t1 is not None and t2 is not None:
-        lo, hi = min(t1, t2), max(t1, t2)
-        return df_p.loc[(dt >= lo) & (dt <= hi)]
-    return df_p
+def _excel_celula_serie(val):
+    if val is None or (isinstance(val, float) and pd.isna(val)):
+        return ""
+    if isinstance(val, (int, float)) and not isinstance(val, bool):
+        try:
+            f = float(val)
+            if f.is_integer():
+                return str(int(f))
+        except (ValueError, OverflowError):
+            pass
+    return str(val).strip()
 
 
-def _v2_aplicar_filtro_faixa_nota(df_p: pd.DataFrame, modo: str, n1: int, n2: int) -> pd.DataFrame:
-    if df_p.empty or not modo or "Nota" not in df_p.columns:
-        return df_p
-    nn = pd.to_numeric(df_p["Nota"], errors="coerce")
-    if modo == ">=":
-        return df_p.loc[nn >= n1]
-    if modo == "<=":
-        return df_p.loc[nn <= n1]
-    if modo == "=":
-        return df_p.loc[nn == n1]
-    if modo == "entre":
-        lo, hi = min(n1, n2), max(n1, n2)
-        return df_p.loc[(nn >= lo) & (nn <= hi)]
-    return df_p
+def _coluna_por_palavras(nomes_cols, palavras, ja_usados):
+    """Índice da primeira coluna cujo nome contém alguma palavra-chave (não em ja_usados)."""
+    for i, nome in enumerate(nomes_cols):
+        if i in ja_usados:
+            continue
+        c = str(nome).strip().lower().replace("_", " ")
+        comp = c.replace(" ", "")
+        for p in palavras:
+            p2 = p.lower().replace(" ", "")
+            if p2 in comp or p.lower() in c:
+                return i
+    return None
 
 
-def filtrar_df_geral_para_exportacao(
-    df_base,
-    filtro_origem,
-    filtro_tipos,
-    filtro_series,
-    filtro_status_labels,
-    filtro_operacao_labels,
-    filtro_data_modo_label,
-    filtro_data_d1,
-    filtro_data_d2,
-    filtro_faixa_modo_label,
-    filtro_faixa_n1,
-    filtro_faixa_n2,
-    filtro_ufs,
-    nota_esp_chave="",
-    nota_esp_num=0,
-    nota_esp_serie="",
-    terceiros_status_labels=None,
-    terceiros_tipos=None,
-    terceiros_operacao_labels=None,
-    terceiros_data_modo_label="Qualquer",
-    terceiros_data_d1=None,
-    terceiros_data_d2=None,
-    *,
-    skip_filtro_serie=False,
-    skip_filtro_uf=False,
-    skip_nota_especifica=False,
-):
+def extrair_faixas_ini_fim_serie_excel(arquivo_excel):
     """
-    filtro_origem: aplica-se a todas as linhas (própria e/ou terceiros), antes do resto.
-    Critérios v2_f_*: emissão própria.
-    Nota específica (chave(s) 44 dígitos, INUT_… ou n.º+série): própria e terceiros, como no Garimpeiro Raiz.
-    Critérios terceiros_*: só linhas de terceiros (XML recebidos).
+    Planilha com numeração inicial, final e série (3 colunas).
+    Aceita cabeçalhos em português ou dados nas colunas A, B, C sem título.
+    Retorno: (lista de dicts n_ini, n_fim, serie, linhas_ignoradas, mensagem_erro).
     """
-    if df_base is None or df_base.empty:
-        return df_base
-    out = df_base.copy()
-    if len(filtro_origem) > 0:
-        pat = "|".join([re.escape(o.split()[0]) for o in filtro_origem])
-        out = out[out["Origem"].str.contains(pat, regex=True, na=False)]
+    try:
+        df = pd.read_excel(arquivo_excel)
+    except Exception:
+        return [], 0, "Não foi possível ler o ficheiro Excel."
 
-    mask_p = _mask_emissao_propria_df(out)
-    out_p = out.loc[mask_p].copy()
-    out_t = out.loc[~mask_p].copy()
+    if df is None or df.empty:
+        return [], 0, "Planilha vazia."
 
-    st_vals = v2_status_labels_para_valores(filtro_status_labels)
-    if st_vals:
-        out_p = out_p[out_p["Status Final"].isin(st_vals)]
+    nomes = list(df.columns)
+    lowered = [str(x).strip().lower() for x in nomes]
 
-    if len(filtro_tipos) > 0:
-        out_p = out_p[out_p["Modelo"].isin(filtro_tipos)]
+    i_ini = _coluna_por_palavras(
+        lowered,
+        [
+            "numeracao inicial",
+            "numeração inicial",
+            "nota inicial",
+            "n inicial",
+            "inicial",
+            "inicio",
+            "início",
+        ],
+        set(),
+    )
+    i_fim = _coluna_por_palavras(
+        lowered,
+        [
+            "numeracao final",
+            "numeração final",
+            "nota final",
+            "n final",
+            "final",
+            "fim",
+            "até",
+            "ate",
+        ],
+        {i_ini} if i_ini is not None else set(),
+    )
+    _us_ser = set()
+    if i_ini is not None:
+        _us_ser.add(i_ini)
+    if i_fim is not None:
+        _us_ser.add(i_fim)
+    i_ser = _coluna_por_palavras(
+        lowered,
+        ["serie", "série", "ser"],
+        _us_ser,
+    )
 
-    op_int = v2_op_labels_para_interno(filtro_operacao_labels)
-    if op_int and "Operação" in out_p.columns:
-        out_p = out_p[out_p["Operação"].isin(op_int)]
+    if i_ini is None or i_fim is None or i_ser is None:
+        if len(nomes) >= 3:
+            i_ini, i_fim, i_ser = 0, 1, 2
+        else:
+            return (
+                [],
+                0,
+                "Indique 3 colunas (inicial, final, série) ou use cabeçalhos reconhecíveis.",
+            )
 
-    modo_d = _v2_parse_modo_data(filtro_data_modo_label or "Qualquer")
-    out_p = _v2_aplicar_filtro_data_emissao(out_p, modo_d, filtro_data_d1, filtro_data_d2)
+    c_ini, c_fim, c_ser = nomes[i_ini], nomes[i_fim], nomes[i_ser]
+    faixas = []
+    ignoradas = 0
 
-    if not skip_filtro_serie and len(filtro_series) > 0:
-        ser_set = {str(x) for x in filtro_series}
-        out_p = out_p[out_p["Série"].astype(str).isin(ser_set)]
+    for _, row in df.iterrows():
+        n0 = _excel_celula_int(row[c_ini])
+        n1 = _excel_celula_int(row[c_fim])
+        ser = _excel_celula_serie(row[c_ser])
+        if n0 is None or n1 is None or not ser:
+            ignoradas += 1
+            continue
+        if n0 > n1:
+            n0, n1 = n1, n0
+        if (n1 - n0 + 1) > _MAX_FAIXA_EXPORT_DOM:
+            ignoradas += 1
+            continue
+        faixas.append({"n_ini": n0, "n_fim": n1, "serie": ser})
+
+    if not faixas:
+        msg = "Nenhuma linha válida."
+        if ignoradas:
+            msg += f" ({ignoradas} linha(s) ignorada(s): vazias, série em falta ou faixa acima de {_MAX_FAIXA_EXPORT_DOM} notas.)"
+        return [], ignoradas, msg
+
+    return faixas, ignoradas, None
 
-    modo_f = _v2_parse_modo_faixa(filtro_faixa_modo_label or "Qualquer")
-    if modo_f and len(filtro_series) > 0:
-        n1 = int(filtro_faixa_n1) if filtro_faixa_n1 is not None else 0
-        n2 = int(filtro_faixa_n2) if filtro_faixa_n2 is not None else n1
-        out_p = _v2_aplicar_filtro_faixa_nota(out_p, modo_f, n1, n2)
 
-    if not skip_filtro_uf and len(filtro_ufs) > 0 and "UF Destino" in out_p.columns:
-        ufs = {str(u).strip().upper() for u in filtro_ufs}
-        out_p = out_p[out_p["UF Destino"].astype(str).str.upper().isin(ufs)]
+_MAX_CHAVES_EXCEL_FAIXAS = 75000  # Limite de chaves agregadas por planilha (várias linhas)
 
-    out_p = _v2_aplicar_nota_especifica_propria(
-        out_p,
-        nota_esp_chave,
-        nota_esp_num,
-        nota_esp_serie,
-        skip=skip_nota_especifica,
-    )
 
-    _t_st_lab = list(terceiros_status_labels or [])
-    _t_tip = list(terceiros_tipos or [])
-    _t_op_lab = list(terceiros_operacao_labels or [])
-    st_t_vals = v2_status_labels_para_valores(_t_st_lab)
-    if st_t_vals and not out_t.empty:
-        out_t = out_t[out_t["Status Final"].isin(st_t_vals)]
-    if len(_t_tip) > 0 and not out_t.empty:
-        out_t = out_t[out_t["Modelo"].isin(_t_tip)]
-    op_t_int = v2_op_labels_para_interno(_t_op_lab)
-    if op_t_int and not out_t.empty and "Operação" in out_t.columns:
-        out_t = out_t[out_t["Operação"].isin(op_t_int)]
-    modo_td = _v2_parse_modo_data(terceiros_data_modo_label or "Qualquer")
-    if not out_t.empty:
-        out_t = _v2_aplicar_filtro_data_emissao(
-            out_t, modo_td, terceiros_data_d1, terceiros_data_d2
+def chaves_agregadas_de_excel_faixas(df_geral, faixas_lista, modelo):
+    """Cruza cada faixa com o relatório geral; devolve (chaves únicas, cortado_por_limite)."""
+    if df_geral is None or df_geral.empty or not faixas_lista:
+        return [], False
+    vistos = set()
+    ordenadas = []
+    for fx in faixas_lista:
+        ch_sub = chaves_por_faixa_numeracao(
+            df_geral,
+            modelo,
+            fx["serie"],
+            fx["n_ini"],
+            fx["n_fim"],
         )
+        for ch in ch_sub:
+            if ch not in vistos:
+                vistos.add(ch)
+                ordenadas.append(ch)
+                if len(ordenadas) >= _MAX_CHAVES_EXCEL_FAIXAS:
+                    return ordenadas, True
+    return ordenadas, False
 
-    out_t = _v2_aplicar_nota_especifica_propria(
-        out_t,
-        nota_esp_chave,
-        nota_esp_num,
-        nota_esp_serie,
-        skip=skip_nota_especifica,
-    )
 
-    if out_p.empty and out_t.empty:
-        return out_p
-    if out_p.empty:
-        return out_t.reset_index(drop=True)
-    if out_t.empty:
-        return out_p.reset_index(drop=True)
-    return pd.concat([out_p, out_t], ignore_index=True)
+def _nome_xml_raiz_zip_unico(usados, nome_arquivo):
+    """Nome dentro do ZIP só na raiz; evita colisão se houver ficheiros homónimos."""
+    base = os.path.basename(str(nome_arquivo).replace("\\", "/"))
+    if not base or base in (".", ".."):
+        base = "documento.xml"
+    if base not in usados:
+        usados.add(base)
+        return base
+    stem, ext = os.path.splitext(base)
+    if not ext:
+        ext = ".xml"
+    k = 2
+    while True:
+        cand = f"{stem}_{k}{ext}"
+        if cand not in usados:
+            usados.add(cand)
+            return cand
+        k += 1
 
 
-def _mask_terceiros_df(df: pd.DataFrame) -> pd.Series:
-    """Linhas cujo relatório indica documento recebido de terceiros."""
-    if df is None or df.empty or "Origem" not in df.columns:
-        return pd.Series(dtype=bool)
-    return df["Origem"].astype(str).str.contains("TERCEIROS", case=False, na=False)
+def _chave44_digitos(ch):
+    d = "".join(filter(str.isdigit, str(ch or "")))
+    if len(d) >= 44:
+        return d[:44]
+    return None
 
 
-def _df_apenas_emissao_propria(df: pd.DataFrame) -> pd.DataFrame:
-    if df is None or not isinstance(df, pd.DataFrame) or df.empty:
-        return pd.DataFrame()
-    if "Origem" not in df.columns:
-        return df.reset_index(drop=True)
-    mp = _mask_emissao_propria_df(df)
-    mt = _mask_terceiros_df(df)
-    # Própria explícita, ou linhas sem etiqueta clara (não ficam só de fora dos dois lotes)
-    m = mp | (~mp & ~mt)
-    return df.loc[m].reset_index(drop=True)
+def _chaves_lista_do_df(df):
+    """Chaves NFe 44 dígitos únicas, por ordem de aparição."""
+    if df is None or df.empty or "Chave" not in df.columns:
+        return []
+    out = []
+    for v in df["Chave"].tolist():
+        k = _chave44_digitos(v)
+        if k:
+            out.append(k)
+    return list(dict.fromkeys(out))
 
 
-def _df_apenas_terceiros(df: pd.DataFrame) -> pd.DataFrame:
-    if df is None or not isinstance(df, pd.DataFrame) or df.empty:
-        return pd.DataFrame()
-    if "Origem" not in df.columns:
-        return pd.DataFrame()
-    mt = _mask_terceiros_df(df)
-    return df.loc[mt].reset_index(drop=True)
+def _df_sig_hash_memo(df):
+    if df is None or df.empty:
+        return "empty"
+    try:
+        h = pd.util.hash_pandas_object(df.reset_index(drop=True), index=True)
+        return hashlib.md5(h.values.tobytes()).hexdigest()
+    except Exception:
+        return hashlib.md5(
+            f"{len(df)}|{list(df.columns)}".encode("utf-8", errors="replace")
+        ).hexdigest()
 
 
-def _folhas_detalhe_terceiros_do_subset(df: pd.DataFrame) -> dict:
+def _df_sig_hash_frame(df):
+    """`_df_sig_hash_memo` calculado uma vez por DataFrame vivo (ver `_df_memo_por_frame`)."""
+    if df is None or df.empty:
+        return "empty"
+    return _df_memo_por_frame(df, "sig_hash", _df_sig_hash_memo)
+
+
+def _excel_ficheiro_memo(df_work, sheet_name):
     """
-    Folhas do livro Excel alinhadas ao painel «terceiros»: canceladas, autorizadas,
-    denegadas e rejeitadas a partir de linhas TERCEIROS. Buracos e inutilizadas
-    não se aplicam a XML recebido de terceiros — df_bur e df_inu ficam sempre vazios.
+    Excel da vista filtrada pela cache de relatórios (caminho para `_st_download_ficheiro`) — só se gera de
+    novo quando o DataFrame muda (evita recalcular a cada clique noutros widgets da zona de relatório / Etapa 3);
+    nem a sessão nem o rerun guardam bytes.
     """
-    empty = pd.DataFrame()
-    if df is None or not isinstance(df, pd.DataFrame) or df.empty:
-        return {
-            "df_bur": empty,
-            "df_inu": empty,
-            "df_can": empty,
-            "df_aut": empty,
-            "df_den": empty,
-            "df_rej": empty,
-        }
-    df_t = df.loc[_mask_terceiros_df(df)].copy()
-    if df_t.empty or "Status Final" not in df_t.columns:
-        return {
-            "df_bur": empty,
-            "df_inu": empty,
-            "df_can": empty,
-            "df_aut": empty,
-            "df_den": empty,
-            "df_rej": empty,
-        }
-    stu = df_t["Status Final"].astype(str).str.upper()
-    return {
-        "df_bur": empty,
-        "df_inu": empty,
-        "df_can": df_t.loc[stu.eq("CANCELADOS")].reset_index(drop=True),
-        "df_aut": df_t.loc[stu.eq("NORMAIS")].reset_index(drop=True),
-        "df_den": df_t.loc[stu.eq("DENEGADOS")].reset_index(drop=True),
-        "df_rej": df_t.loc[stu.eq("REJEITADOS")].reset_index(drop=True),
-    }
+    if df_work is None or df_work.empty:
+        return None
 
+    def _gerar(caminho):
+        df_ex = (
+            _df_com_data_emissao_dd_mm_yyyy(df_work.copy())
+            if "Data Emissão" in df_work.columns
+            else df_work.copy()
+        )
+        return dataframe_para_excel_ficheiro(df_ex, sheet_name, caminho)
 
-def _v2_limpar_zips_gerados_etapa3(output_dir=None):
-    """Política: não apagar ZIP já gravados no disco — só gravar novos por cima se o nome repetir."""
-    return
+    return _artefacto_cache("tabela", [sheet_name, _df_sig_hash_frame(df_work), list(map(str, df_work.columns))], _gerar)
 
 
-def _v2_excel_bytes_filtrado_etapa3(df: pd.DataFrame):
-    """Um .xlsx com folhas Filtrado e Resumo_status (igual ao ramo excel_filtro da Etapa 3)."""
-    if df is None or df.empty:
-        return None
-    buffer_excel = io.BytesIO()
-    with pd.ExcelWriter(buffer_excel, engine="xlsxwriter") as writer:
-        _df_xls_f = _df_com_data_emissao_dd_mm_yyyy(df.reset_index(drop=True))
-        _df_xls_f.to_excel(writer, sheet_name="Filtrado", index=False)
-        rs = (
-            _df_xls_f.groupby("Status Final", dropna=False)
-            .size()
-            .reset_index(name="Quantidade")
-        )
-        rs.to_excel(writer, sheet_name="Resumo_status", index=False)
-    return buffer_excel.getvalue()
+# --- GRELHA AG GRID DO RELATÓRIO: página, filtro e ordenação no servidor ---
+# O browser só recebe uma página de linhas; o modelo de filtro/ordenação que a grelha devolve (gridState) é
+# aplicado aqui, sobre um índice por coluna memorizado por DataFrame, com a mesma semântica dos filtros simples
+# do AG Grid (texto sem distinção de maiúsculas, número/data, AND/OR). As linhas visíveis para Excel/ZIP são
+# posições no DataFrame, sem JSON de volta.
+_AGGRID_LINHAS_POR_PAGINA = 500
+_AGGRID_MAX_VISTAS = 4
 
 
-def excel_bytes_relatorio_bloco(df_filtrado: pd.DataFrame, chaves_bloco: set):
-    """Bytes de um .xlsx só com as linhas cujas Chave aparecem no bloco de XML (máx. 10k ficheiros)."""
-    if df_filtrado is None or df_filtrado.empty or not chaves_bloco:
-        return None
-    if "Chave" not in df_filtrado.columns:
+def _aggrid_texto_js(v):
+    """Texto que o filtro de texto do AG Grid vê para a célula (`String(valor)`); None para vazio/NaN."""
+    if v is None:
         return None
-    _norm = df_filtrado["Chave"].map(_chave_para_conjunto_export)
-    dfp = df_filtrado.loc[_norm.isin(chaves_bloco)]
-    if dfp.empty:
-        return None
-    dfp = _df_com_data_emissao_dd_mm_yyyy(dfp.reset_index(drop=True))
-    buf = io.BytesIO()
-    with pd.ExcelWriter(buf, engine="xlsxwriter") as writer:
-        dfp.to_excel(writer, sheet_name="Filtrado", index=False)
-        rs = (
-            dfp.groupby("Status Final", dropna=False)
-            .size()
-            .reset_index(name="Quantidade")
-        )
-        rs.to_excel(writer, sheet_name="Resumo_status", index=False)
-    return buf.getvalue()
+    try:
+        if pd.isna(v):
+            return None
+    except (TypeError, ValueError):
+        pass
+    if isinstance(v, (bool, np.bool_)):
+        return "true" if v else "false"
+    if isinstance(v, (float, np.floating)) and float(v).is_integer():
+        return str(int(v))
+    return str(v)
 
 
-def _excel_bytes_pacote_contabilidade(
-    df_todas_lidas: pd.DataFrame, df_xml_pacote: pd.DataFrame
-):
+def _aggrid_indice_calcular(df: pd.DataFrame) -> dict:
+    # Tipos das colunas como a grelha os recebe (formatação de exibição numa linha): decidem o filtro de cada coluna.
+    modelo = _df_relatorio_leitura_abas_para_exibicao_sem_sep_milhar(df.iloc[:1].reset_index(drop=True))
+    tipos = {}
+    for c, dt in modelo.dtypes.items():
+        tipos[c] = "number" if dt.kind in "iuf" else ("date" if dt.kind == "M" else "text")
+    return {"n": len(df), "tipos": tipos, "vazio": modelo.iloc[0:0], "cols": {}, "vistas": {}}
+
+
+def _aggrid_indice(df: pd.DataFrame) -> dict:
+    return _df_memo_por_frame(df, "indice_aggrid", _aggrid_indice_calcular)
+
+
+def _aggrid_coluna(idx: dict, df: pd.DataFrame, col: str):
     """
-    Excel para envio à contabilidade: folha «Todas_lidas» + resumo; se df_xml_pacote for outro
-    DataFrame (não o mesmo objeto que df_todas_lidas), acrescenta XML_neste_pacote e resumo.
-    Folhas com datas em dd/mm/aaaa.
-    Devolve bytes ou None se falhar por disco/temp cheio (errno 28).
+    (códigos por linha, valores distintos como a grelha os mostra, posto de ordenação de cada distinto) — a
+    formatação de exibição corre só nos valores distintos, uma vez por coluna usada num filtro ou ordenação.
     """
-    has_t = df_todas_lidas is not None and not df_todas_lidas.empty
-    has_x = df_xml_pacote is not None and not df_xml_pacote.empty
-    mesmo_lote = has_t and has_x and (df_xml_pacote is df_todas_lidas)
-    if not has_t and not has_x:
-        try:
-            buf0 = io.BytesIO()
-            with pd.ExcelWriter(buf0, engine="xlsxwriter") as w0:
-                pd.DataFrame({"Info": ["Sem linhas para exportar no Excel do pacote."]}).to_excel(
-                    w0, sheet_name="Aviso", index=False
-                )
-            return buf0.getvalue()
-        except Exception as e:
-            if _erro_sem_espaco_disco(e):
+    ent = idx["cols"].get(col)
+    if ent is not None:
+        return ent
+    codigos, unicos = pd.factorize(df[col], use_na_sentinel=True)
+    codigos = np.where(codigos < 0, len(unicos), codigos)
+    distintos = pd.concat([pd.Series(unicos, dtype=object), pd.Series([None], dtype=object)], ignore_index=True)
+    exib = _df_relatorio_leitura_abas_para_exibicao_sem_sep_milhar(pd.DataFrame({col: distintos}))[col]
+    tipo = idx["tipos"].get(col, "text")
+    if tipo == "number":
+        vals = pd.to_numeric(exib, errors="coerce").to_numpy(dtype="float64", na_value=np.nan)
+        chaves = [(0, 0.0) if np.isnan(v) else (1, float(v)) for v in vals]
+    elif tipo == "date":
+        vals = pd.to_datetime(exib, errors="coerce").to_numpy(dtype="datetime64[ns]")
+        chaves = [(0, 0) if np.isnat(v) else (1, int(v.astype("int64"))) for v in vals]
+    else:
+        vals = np.array([_aggrid_texto_js(v) for v in exib], dtype=object)
+        chaves = [(0, "") if v is None else (1, v) for v in vals]
+    # Ordenação por defeito do AG Grid: vazios primeiro, texto por código de carácter (com maiúsculas).
+    ordem = sorted(range(len(chaves)), key=chaves.__getitem__)
+    posto = np.zeros(len(chaves), dtype=np.int64)
+    r = 0
+    for i, j in enumerate(ordem):
+        if i and chaves[j] != chaves[ordem[i - 1]]:
+            r += 1
+        posto[j] = r
+    ent = (codigos, tipo, vals, posto)
+    idx["cols"][col] = ent
+    return ent
+
+
+def _aggrid_mask_condicao(tipo: str, vals: np.ndarray, cond: dict) -> np.ndarray:
+    """Uma condição de filtro simples do AG Grid avaliada nos valores distintos (True = passa)."""
+    op = cond.get("type") or ""
+    k = len(vals)
+    if tipo == "text":
+        nulo = np.array([v is None for v in vals], dtype=bool)
+        branco = nulo | np.array([v is not None and not v.strip() for v in vals], dtype=bool)
+        if op == "blank":
+            return branco
+        if op == "notBlank":
+            return ~branco
+        f = cond.get("filter")
+        if f is None:
+            return np.ones(k, dtype=bool)
+        f = str(f).lower()
+        baixo = [("" if v is None else v.lower()) for v in vals]
+        teste = {
+            "contains": lambda t: f in t,
+            "notContains": lambda t: f not in t,
+            "equals": lambda t: t == f,
+            "notEqual": lambda t: t != f,
+            "startsWith": lambda t: t.startswith(f),
+            "endsWith": lambda t: t.endswith(f),
+        }.get(op)
+        if teste is None:
+            return np.ones(k, dtype=bool)
+        m = np.fromiter((teste(t) for t in baixo), dtype=bool, count=k)
+        # Célula vazia (null) só passa nos filtros negativos, como no AG Grid.
+        return np.where(nulo, op in ("notEqual", "notContains"), m)
+    if tipo == "date":
+        nulo = np.isnat(vals)
+
+        def _v(chave):
+            try:
+                return pd.Timestamp(cond.get(chave)).to_datetime64() if cond.get(chave) else None
+            except (TypeError, ValueError):
                 return None
-            raise
-    try:
-        buf = io.BytesIO()
-        with pd.ExcelWriter(buf, engine="xlsxwriter") as writer:
-            if has_t:
-                d1 = _df_com_data_emissao_dd_mm_yyyy(df_todas_lidas.reset_index(drop=True))
-                d1.to_excel(writer, sheet_name="Todas_lidas", index=False)
-                if "Status Final" in d1.columns:
-                    rs = (
-                        d1.groupby("Status Final", dropna=False)
-                        .size()
-                        .reset_index(name="Quantidade")
-                    )
-                    rs.to_excel(writer, sheet_name="Resumo_todas", index=False)
-            if has_x and not mesmo_lote:
-                d2 = _df_com_data_emissao_dd_mm_yyyy(df_xml_pacote.reset_index(drop=True))
-                d2.to_excel(writer, sheet_name="XML_neste_pacote", index=False)
-                if "Status Final" in d2.columns:
-                    r2 = (
-                        d2.groupby("Status Final", dropna=False)
-                        .size()
-                        .reset_index(name="Quantidade")
-                    )
-                    r2.to_excel(writer, sheet_name="Resumo_XML_pacote", index=False)
-        return buf.getvalue()
-    except Exception as e:
-        if _erro_sem_espaco_disco(e):
-            return None
-        raise
 
+        f, f2 = _v("dateFrom"), _v("dateTo")
+    else:
+        nulo = np.isnan(vals)
 
-def _excel_bytes_geral_e_resumo_status(df: pd.DataFrame) -> bytes:
-    """Um .xlsx com folhas Geral e Resumo_status (datas em dd/mm/aaaa)."""
-    buf = io.BytesIO()
-    _ddf = _df_com_data_emissao_dd_mm_yyyy(df.reset_index(drop=True))
-    with pd.ExcelWriter(buf, engine="xlsxwriter") as writer:
-        _ddf.to_excel(writer, sheet_name="Geral", index=False)
-        rs = (
-            _ddf.groupby("Status Final", dropna=False)
-            .size()
-            .reset_index(name="Quantidade")
-        )
-        rs.to_excel(writer, sheet_name="Resumo_status", index=False)
-    return buf.getvalue()
+        def _v(chave):
+            try:
+                return float(cond.get(chave)) if cond.get(chave) is not None else None
+            except (TypeError, ValueError):
+                return None
+
+        f, f2 = _v("filter"), _v("filterTo")
+    if op == "blank":
+        return nulo
+    if op == "notBlank":
+        return ~nulo
+    if f is None:
+        return np.ones(k, dtype=bool)
+    with np.errstate(invalid="ignore"):
+        if op == "equals":
+            m = vals == f
+        elif op == "notEqual":
+            m = vals != f
+        elif op == "lessThan":
+            m = vals < f
+        elif op == "lessThanOrEqual":
+            m = vals <= f
+        elif op == "greaterThan":
+            m = vals > f
+        elif op == "greaterThanOrEqual":
+            m = vals >= f
+        elif op == "inRange" and f2 is not None:
+            # inRangeInclusive=false por defeito: extremos de fora.
+            m = (vals > min(f, f2)) & (vals < max(f, f2))
+        else:
+            return np.ones(k, dtype=bool)
+    return np.asarray(m, dtype=bool) & ~nulo
+
+
+def _aggrid_mask_filtro(tipo: str, vals: np.ndarray, modelo: dict) -> np.ndarray:
+    """Modelo de filtro de uma coluna: condição única ou `conditions` / `condition1`+`condition2` com AND/OR."""
+    conds = modelo.get("conditions")
+    if conds is None and "condition1" in modelo:
+        conds = [c for c in (modelo.get("condition1"), modelo.get("condition2")) if c]
+    if not conds:
+        return _aggrid_mask_condicao(tipo, vals, modelo)
+    ms = [_aggrid_mask_condicao(tipo, vals, c) for c in conds if isinstance(c, dict)]
+    if not ms:
+        return np.ones(len(vals), dtype=bool)
+    if str(modelo.get("operator") or "AND").upper() == "OR":
+        return np.logical_or.reduce(ms)
+    return np.logical_and.reduce(ms)
+
+
+def _aggrid_modelos_do_estado(valor) -> tuple:
+    """(filterModel, sortModel) do último `gridState` devolvido pela grelha (valor do componente na sessão)."""
+    estado = valor.get("gridState") if isinstance(valor, dict) else None
+    if not isinstance(estado, dict):
+        return {}, []
+    fm = (estado.get("filter") or {}).get("filterModel") or {}
+    sm = (estado.get("sort") or {}).get("sortModel") or []
+    return (fm if isinstance(fm, dict) else {}), (sm if isinstance(sm, list) else [])
+
+
+def _aggrid_vista(df: pd.DataFrame, filtro: dict, ordenacao: list) -> pd.DataFrame:
+    """
+    `df` restrito e ordenado pelo modelo da grelha. O mesmo objecto volta nos reruns seguintes (memo no índice),
+    e sem filtro nem ordenação é o próprio `df` — assinaturas, Excel e ZIP a jusante não recalculam.
+    """
+    idx = _aggrid_indice(df)
+    filtro = {c: m for c, m in (filtro or {}).items() if c in df.columns and isinstance(m, dict)}
+    ordenacao = [
+        s for s in (ordenacao or []) if isinstance(s, dict) and s.get("colId") in df.columns and s.get("sort")
+    ]
+    sig = json.dumps([filtro, ordenacao], sort_keys=True, default=str)
+    vistas = idx["vistas"]
+    if sig in vistas:
+        vistas[sig] = vistas.pop(sig)
+        return vistas[sig]
+    if not filtro and not ordenacao and isinstance(df.index, pd.RangeIndex) and df.index.start == 0 and df.index.step == 1:
+        out = df
+    else:
+        m = np.ones(len(df), dtype=bool)
+        for c, mod in filtro.items():
+            codigos, tipo, vals, _posto = _aggrid_coluna(idx, df, c)
+            m &= _aggrid_mask_filtro(tipo, vals, mod)[codigos]
+        pos = np.flatnonzero(m)
+        if ordenacao and len(pos):
+            chaves = []
+            for s in ordenacao:
+                codigos, _tipo, _vals, posto = _aggrid_coluna(idx, df, s["colId"])
+                p = posto[codigos[pos]]
+                chaves.append(-p if str(s["sort"]).lower() == "desc" else p)
+            # lexsort: última chave é a principal; estável (empates mantêm a ordem original, como no AG Grid).
+            pos = pos[np.lexsort(chaves[::-1])]
+        out = df.iloc[pos].reset_index(drop=True)
+    while len(vistas) >= _AGGRID_MAX_VISTAS:
+        vistas.pop(next(iter(vistas)))
+    vistas[sig] = out
+    return out
 
 
-def _v2_export_zip_etapa3(
-    df_g_base: pd.DataFrame,
-    *,
-    xml_respeita_filtro: bool,
-    df_filtrado_para_excel_bloco=None,
-    excel_um_so_completo: bool,
-    df_excel_completo: pd.DataFrame,
-    v2_zip_org: bool,
-    v2_zip_plano: bool,
-    cnpj_limpo: str,
-    zip_tag=None,
-    zip_output_dir=None,
-    zip_nome_ficheiro="",
-    pacote_pastas_garimpo: bool = False,
-    pacote_pastas_contabilidade: bool = False,
-    df_excel_todas_notas=None,
-):
+def _relatorio_leitura_tabela_aggrid(df_raw: pd.DataFrame, grid_key: str, height: int = 420):
     """
-    Escreve ZIP(s) em disco (org / plano).
-    Devolve (org_parts, todos_parts, xml_matched, aviso_sem_xml|None, excel_pacote_matriz_solta|None).
-    xml_respeita_filtro=False â†’ todos os XML cujo resumo está em df_g_base.
-    excel_um_so_completo=True â†’ em cada parte, o mesmo Excel com df_excel_completo (relatório inteiro).
-    zip_tag: ex. «propria» / «terceiros» para nomes z_org_propria_pt1.zip (dois lotes independentes).
-    zip_output_dir: pasta onde gravar os .zip (None = diretório de trabalho atual).
-    zip_nome_ficheiro: opcional — base do nome (ex.: GarimpoMarco â†’ GarimpoMarco_org_propria_pt1.zip).
-    pacote_pastas_garimpo=True â†’ um ZIP só «com pastas»; stem = zip_nome_ficheiro ou pacote_apuracao_ptN.zip.
-    pacote_pastas_contabilidade=True â†’ ZIP por grupo `EP_AAAA_MM_Serie_…_Entrada|Saida_…_modelo` ou `T_AAAA_MM_…_modelo`; XML em XML/Lote_001…;
-    Excel na raiz do ZIP;
-    Excel em cada ZIP: mesmo conteúdo (todo o lido), nome `relatorio_garimpeiro_<grupo>.xlsx` (sem Painel Fiscal).
-    df_excel_todas_notas: DataFrame do relatório geral (df_geral) para a folha «Todas_lidas».
+    Grelha Ag-Grid: filtro e ordenação no cabeçalho de cada coluna (comportamento próximo do Excel).
+    Devolve o DataFrame original (`df_raw`) restrito às linhas visíveis após filtro/ordenação,
+    para Excel e ZIP XML. O filtro, a ordenação e a paginação correm no servidor (`_aggrid_vista`);
+    a grelha só recebe as linhas da página.
     """
-    out_dir = (
-        Path(zip_output_dir).resolve()
-        if zip_output_dir is not None
-        else Path(".").resolve()
-    )
-    if pacote_pastas_garimpo:
-        u = _v2_sanitize_nome_export(zip_nome_ficheiro or "", max_len=80)
-        stem_org = u if u else "pacote_apuracao"
-        stem_todos = "z_todos_unused"
-    else:
-        stem_org, stem_todos = _v2_stems_zip_nome_ficheiro_etapa3(
-            zip_nome_ficheiro or "", zip_tag
+    if df_raw is None or df_raw.empty:
+        return df_raw
+
+    try:
+        from st_aggrid import AgGrid, GridOptionsBuilder, DataReturnMode
+    except ImportError:
+        st.error(
+            "Instale **streamlit-aggrid** no mesmo Python do Streamlit: "
+            "`pip install streamlit-aggrid`"
         )
-    if df_g_base is None or df_g_base.empty or "Chave" not in df_g_base.columns:
-        return [], [], 0, "ERR:Relatório geral vazio ou sem coluna Chave.", None
-    if xml_respeita_filtro:
-        if df_filtrado_para_excel_bloco is None or df_filtrado_para_excel_bloco.empty:
-            return [], [], 0, "ERR:Resultado filtrado: 0 linhas. Ajuste os filtros.", None
-        _df_ch = df_filtrado_para_excel_bloco
+        st.dataframe(
+            _df_relatorio_leitura_abas_para_exibicao_sem_sep_milhar(df_raw),
+            hide_index=True,
+            height=height,
+        )
+        return df_raw
+
+    # Valor do componente já actualizado pelo último filterChanged/sortChanged (antes deste rerun).
+    filtro, ordenacao = _aggrid_modelos_do_estado(st.session_state.get(grid_key))
+    df_vis = _aggrid_vista(df_raw, filtro, ordenacao)
+
+    total = len(df_vis)
+    n_pag = max(1, -(-total // _AGGRID_LINHAS_POR_PAGINA))
+    k_pag = f"{grid_key}__pagina"
+    k_sig = f"{grid_key}__modelo"
+    sig = json.dumps([filtro, ordenacao], sort_keys=True, default=str)
+    if st.session_state.get(k_sig) != sig:
+        st.session_state[k_sig] = sig
+        st.session_state[k_pag] = 1
+    elif int(st.session_state.get(k_pag) or 1) > n_pag:
+        st.session_state[k_pag] = n_pag
+    pagina = 1
+    if n_pag > 1:
+        c_pag, c_info = st.columns([1, 3])
+        with c_pag:
+            pagina = int(
+                st.number_input("Página", min_value=1, max_value=n_pag, step=1, key=k_pag)
+            )
+        ini = (pagina - 1) * _AGGRID_LINHAS_POR_PAGINA
+        with c_info:
+            st.caption(
+                f"Linhas **{ini + 1}–{min(ini + _AGGRID_LINHAS_POR_PAGINA, total)}** de **{total}** "
+                f"({n_pag} páginas de {_AGGRID_LINHAS_POR_PAGINA})."
+            )
+    ini = (pagina - 1) * _AGGRID_LINHAS_POR_PAGINA
+    df_pag = df_vis.iloc[ini : ini + _AGGRID_LINHAS_POR_PAGINA]
+    if df_pag.empty:
+        df_grid = _aggrid_indice(df_raw)["vazio"]
     else:
-        _df_ch = df_g_base
-    filtro_chaves = {
-        k
-        for k in (_chave_para_conjunto_export(x) for x in _df_ch["Chave"].tolist())
-        if k
-    }
-    if not filtro_chaves:
-        return [], [], 0, "ERR:Nenhuma chave válida para exportar XML.", None
+        df_grid = _df_relatorio_leitura_abas_para_exibicao_sem_sep_milhar(df_pag.reset_index(drop=True))
 
-    excel_fn_completo = (
-        _PACOTE_CONTAB_NOME_EXCEL_RAIZ
-        if pacote_pastas_contabilidade and excel_um_so_completo
-        else "RELATORIO_GARIMPEIRO/relatorio_geral_completo.xlsx"
+    gb = GridOptionsBuilder.from_dataframe(
+        df_grid,
+        editable=False,
+        filter=True,
+        sortable=True,
+        resizable=True,
+    )
+    gb.configure_grid_options(rowHeight=28, headerHeight=36)
+    grid_options = gb.build()
+    # from_dataframe força fitGridWidth e esmaga colunas; removemos para permitir scroll horizontal.
+    grid_options.pop("autoSizeStrategy", None)
+    _dc = dict(grid_options.get("defaultColDef") or {})
+    _dc.setdefault("minWidth", 140)
+    grid_options["defaultColDef"] = _dc
+    grid_options["suppressHorizontalScroll"] = False
+    # Se a grelha for montada de novo (troca de aba), volta com o filtro/ordenação que o servidor aplicou.
+    grid_options["initialState"] = {"filter": {"filterModel": filtro}, "sort": {"sortModel": ordenacao}}
+    _loc = _aggrid_locale_pt_br()
+    if _loc:
+        grid_options["localeText"] = _loc
+
+    AgGrid(
+        df_grid,
+        gridOptions=grid_options,
+        height=height,
+        data_return_mode=DataReturnMode.MINIMAL,
+        theme="streamlit",
+        key=grid_key,
+        show_download_button=False,
+        show_search=False,
+        enable_enterprise_modules=False,
+        update_on=["filterChanged", "sortChanged"],
     )
+    return df_vis
 
-    xb_completo = None
-    aviso_sem_espaco_excel = None
-    if excel_um_so_completo:
-        if pacote_pastas_contabilidade:
-            df_xml_plan = (
-                df_filtrado_para_excel_bloco
-                if xml_respeita_filtro
-                else df_g_base
+
+def _painel_zip_xml_filtrado(prefix, df_filtrado, cnpj_limpo, df_geral_full):
+    """ZIP com XMLs das chaves visíveis após filtros; também prepara descarga «aberta» (XML soltos)."""
+    cur_sig = _df_sig_hash_frame(df_filtrado)
+    kzip = f"{prefix}_zip_parts_ready"
+    kflat = f"{prefix}_xml_flat_ready"
+    ksig = f"{prefix}_zip_src_sig"
+    if st.session_state.get(ksig) != cur_sig:
+        st.session_state.pop(kzip, None)
+        st.session_state.pop(kflat, None)
+    st.session_state[ksig] = cur_sig
+    chaves = _chaves_lista_do_df(df_filtrado)
+    if not chaves:
+        return
+    if st.button(
+        "Gerar ZIP e XML soltos (linhas filtradas)",
+        key=f"{prefix}_btn_zip",
+    ):
+        with st.spinner("A ler o lote e a montar ZIP + lista de XML…"):
+            parts, tot, xml_flat = escrever_zip_dominio_por_chaves(
+                cnpj_limpo, chaves, df_geral_full
+            )
+        st.session_state[kzip] = parts
+        st.session_state[kflat] = xml_flat
+        if tot == 0:
+            st.warning(
+                "Nenhum XML do lote correspondeu a estas chaves (lote vazio ou chaves externas ao lote)."
             )
-            df_todas = df_excel_todas_notas
-            if df_todas is None or getattr(df_todas, "empty", True):
-                df_todas = df_g_base
-            try:
-                xb_completo = excel_relatorio_geral_com_dashboard_bytes(
-                    df_todas, incluir_painel_fiscal=False
-                )
-            except Exception as ex_dash:
-                if _erro_sem_espaco_disco(ex_dash):
-                    aviso_sem_espaco_excel = _msg_sem_espaco_disco_garimpeiro()
-                xb_completo = None
-            if not xb_completo:
-                xb_completo = _excel_bytes_pacote_contabilidade(df_todas, df_xml_plan)
-                if xb_completo is None and not aviso_sem_espaco_excel:
-                    aviso_sem_espaco_excel = _msg_sem_espaco_disco_garimpeiro()
         else:
-            xb_completo = _excel_bytes_geral_e_resumo_status(df_excel_completo)
-
-    if pacote_pastas_contabilidade and v2_zip_org and not v2_zip_plano:
-        paths, empty, xm, av, xls = _v2_export_pacote_contab_por_dimensoes(
-            out_dir,
-            stem_org,
-            filtro_chaves,
-            cnpj_limpo,
-            xb_completo,
-            excel_fn_completo,
-            _df_ch,
+            st.success(
+                f"Incluídos **{tot}** XML(s) em **{len(parts)}** parte(s) ZIP + **{len(xml_flat)}** para descarga aberta."
+            )
+    for idx, part in enumerate(st.session_state.get(kzip) or []):
+        _st_download_ficheiro(
+            rotulo_download_zip_parte(part),
+            part,
+            mime="application/zip",
+            key=f"{prefix}_dlz_{idx}_{hashlib.md5(part.encode()).hexdigest()[:8]}",
         )
-        if aviso_sem_espaco_excel:
-            av = (
-                f"{aviso_sem_espaco_excel} {av}"
-                if av
-                else aviso_sem_espaco_excel
+    _flat = st.session_state.get(kflat) or []
+    if _flat:
+        st.caption(
+            "**XML soltos (aberto)** — um botão por ficheiro; o **ZIP** acima traz o mesmo conjunto com Excel em RELATORIO_GARIMPEIRO/."
+        )
+        chaves_ord = []
+        _seen_ch = set()
+        for _arc, _data, ch44, _td in _flat:
+            if ch44 and ch44 not in _seen_ch:
+                _seen_ch.add(ch44)
+                chaves_ord.append(ch44)
+        xb_ls = _excel_bytes_lista_especifica(df_geral_full, chaves_ord)
+        if xb_ls:
+            st.download_button(
+                "Baixar Excel da lista (mesmas chaves)",
+                data=xb_ls,
+                file_name=f"lista_especifica_{prefix}.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                key=f"{prefix}_dl_xlsx_lista_aberto",
+            )
+        nshow = min(MAX_XML_DOWNLOAD_ABERTO_UI, len(_flat))
+        for ji in range(nshow):
+            arc, data, _ch44, _tdk = _flat[ji]
+            st.download_button(
+                f"\u2b07\ufe0f {arc}",
+                data=data,
+                file_name=os.path.basename(arc),
+                mime="application/xml",
+                key=f"{prefix}_dlxml_{ji}_{hashlib.md5(str(arc).encode()).hexdigest()[:12]}",
+            )
+        if len(_flat) > MAX_XML_DOWNLOAD_ABERTO_UI:
+            st.caption(
+                f"Mostrando os primeiros **{MAX_XML_DOWNLOAD_ABERTO_UI}** de **{len(_flat)}** XML — use o **ZIP** para o pacote completo."
             )
-        return paths, empty, xm, av, xls
 
-    Z = {
-        "z_org": None,
-        "z_todos": None,
-        "org_parts": [],
-        "todos_parts": [],
-        "org_count": 0,
-        "todos_count": 0,
-        "curr_org_part": 1,
-        "curr_todos_part": 1,
-        "chaves_bloco": set(),
-        "seq_bloco": 1,
-        "xml_matched": 0,
-    }
 
-    def _fechar_bloco_zip():
-        if excel_um_so_completo:
-            excel_fn = excel_fn_completo
-            xb = xb_completo
+def _excel_bytes_lista_especifica(df_geral, chaves_ordem_unicas):
+    """
+    Excel com número, série, chave, status, etc., alinhado ao relatório geral.
+    chaves_ordem_unicas: ordem estável das chaves 44 dígitos neste lote ZIP.
+    """
+    if not chaves_ordem_unicas:
+        return None
+    cols_pref = [
+        "Modelo",
+        "Série",
+        "Nota",
+        "Chave",
+        "Status Final",
+        "Origem",
+        "Operação",
+        "Data Emissão",
+        "CNPJ Emitente",
+        "Nome Emitente",
+        "Valor",
+        "Ano",
+        "Mes",
+    ]
+    por_chave = {}
+    if df_geral is not None and not df_geral.empty and "Chave" in df_geral.columns:
+        dfc = df_geral.copy()
+        dfc["_k44"] = dfc["Chave"].map(_chave44_digitos)
+        dfc = dfc[dfc["_k44"].notna()]
+        dfc = dfc.drop_duplicates(subset=["_k44"], keep="first")
+        for _, row in dfc.iterrows():
+            k44 = row["_k44"]
+            por_chave[k44] = row.drop(labels=["_k44"], errors="ignore")
+
+    rows = []
+    vistos = set()
+    for ch in chaves_ordem_unicas:
+        if not ch or ch in vistos:
+            continue
+        vistos.add(ch)
+        if ch in por_chave:
+            rows.append(por_chave[ch].to_dict())
         else:
-            excel_fn = f"RELATORIO_GARIMPEIRO/relatorio_filtrado_pt{Z['seq_bloco']:03d}.xlsx"
-            xb = excel_bytes_relatorio_bloco(
-                df_filtrado_para_excel_bloco, Z["chaves_bloco"]
-            )
-        if xb:
-            if v2_zip_org and Z["z_org"] is not None:
-                Z["z_org"].writestr(excel_fn, xb)
-            if v2_zip_plano and Z["z_todos"] is not None:
-                Z["z_todos"].writestr(excel_fn, xb)
-        Z["chaves_bloco"].clear()
-        Z["seq_bloco"] += 1
-        if (
-            v2_zip_org
-            and Z["z_org"] is not None
-            and Z["org_count"] >= MAX_XML_PER_ZIP
-        ):
-            try:
-                Z["z_org"].close()
-            except OSError:
-                pass
-            Z["curr_org_part"] += 1
-            oname = str(out_dir / f"{stem_org}_pt{Z['curr_org_part']}.zip")
-            Z["z_org"] = _zipfile_open_write_export(oname)
-            Z["org_parts"].append(oname)
-            Z["org_count"] = 0
-        if (
-            v2_zip_plano
-            and Z["z_todos"] is not None
-            and Z["todos_count"] >= MAX_XML_PER_ZIP
-        ):
-            try:
-                Z["z_todos"].close()
-            except OSError:
-                pass
-            Z["curr_todos_part"] += 1
-            tname = str(out_dir / f"{stem_todos}_pt{Z['curr_todos_part']}.zip")
-            Z["z_todos"] = _zipfile_open_write_export(tname)
-            Z["todos_parts"].append(tname)
-            Z["todos_count"] = 0
+            rows.append({"Chave": ch})
 
-    if v2_zip_org:
-        org_name = str(out_dir / f"{stem_org}_pt{Z['curr_org_part']}.zip")
-        Z["z_org"] = _zipfile_open_write_export(org_name)
-        Z["org_parts"].append(org_name)
-    if v2_zip_plano:
-        todos_name = str(out_dir / f"{stem_todos}_pt{Z['curr_todos_part']}.zip")
-        Z["z_todos"] = _zipfile_open_write_export(todos_name)
-        Z["todos_parts"].append(todos_name)
+    out = pd.DataFrame(rows)
+    cols = [c for c in cols_pref if c in out.columns] + [
+        c for c in out.columns if c not in cols_pref
+    ]
+    out = out[[c for c in cols if c in out.columns]]
+    out = _df_com_data_emissao_dd_mm_yyyy(out)
+    buf = io.BytesIO()
+    with pd.ExcelWriter(buf, engine="xlsxwriter") as writer:
+        out.to_excel(writer, sheet_name="Lista", index=False)
+    return buf.getvalue()
 
-    if v2_zip_org or v2_zip_plano:
-        chaves_ja_org = set()
-        chaves_ja_todos = set()
-        for f_name in _lista_nomes_fontes_xml_garimpo():
-            with _abrir_fonte_xml_garimpo_stream(f_name) as f_temp:
-                for name, xml_data in extrair_recursivo(f_temp, f_name):
-                    res, is_p = identify_xml_info(xml_data, cnpj_limpo, name)
-                    ck = _chave_para_conjunto_export(res["Chave"]) if res else None
-                    if res and ck and ck in filtro_chaves:
-                        td = _tupla_dedupe_export_xml(res, ck)
-                        if td is None:
-                            del xml_data
-                            continue
-                        org_ok = (
-                            v2_zip_org
-                            and Z["z_org"] is not None
-                            and td not in chaves_ja_org
-                        )
-                        todos_ok = (
-                            v2_zip_plano
-                            and Z["z_todos"] is not None
-                            and td not in chaves_ja_todos
-                        )
-                        if not org_ok and not todos_ok:
-                            del xml_data
-                            continue
-                        if org_ok:
-                            chaves_ja_org.add(td)
-                            if pacote_pastas_contabilidade:
-                                inner = _caminho_xml_pacote_contab_raiz(res, name)
-                            else:
-                                inner = f"{res['Pasta']}/{name}"
-                            Z["z_org"].writestr(inner, xml_data)
-                            Z["org_count"] += 1
-                        if todos_ok:
-                            chaves_ja_todos.add(td)
-                            Z["z_todos"].writestr(name, xml_data)
-                            Z["todos_count"] += 1
-                        Z["xml_matched"] += int(org_ok) + int(todos_ok)
-                        Z["chaves_bloco"].add(ck)
-                        limite = (
-                            v2_zip_org and Z["org_count"] >= MAX_XML_PER_ZIP
-                        ) or (v2_zip_plano and Z["todos_count"] >= MAX_XML_PER_ZIP)
-                        if limite:
-                            _fechar_bloco_zip()
-                    del xml_data
 
-    if Z["chaves_bloco"] and (
-        (v2_zip_org and Z["org_count"] > 0) or (v2_zip_plano and Z["todos_count"] > 0)
-    ):
-        excel_fn_last = (
-            excel_fn_completo
-            if excel_um_so_completo
-            else f"RELATORIO_GARIMPEIRO/relatorio_filtrado_pt{Z['seq_bloco']:03d}.xlsx"
+def _zip_anexar_excel_lista_especifica(zf, df_geral, chaves_ordem, idx_parte):
+    if not chaves_ordem:
+        return
+    xb = _excel_bytes_lista_especifica(df_geral, chaves_ordem)
+    if xb:
+        zf.writestr(
+            f"RELATORIO_GARIMPEIRO/lista_especifica_pt{idx_parte:03d}.xlsx",
+            xb,
         )
-        if excel_um_so_completo:
-            xb_last = xb_completo
+
+
+def _coletar_xmls_flat_dominio_por_chaves(cnpj_limpo, chaves_lista):
+    """
+    Lê o lote e devolve lista de (nome_na_raiz_do_zip, bytes, chave44, td_dedupe).
+    Mesma deduplicação que o ZIP de domínio (lista específica).
+    """
+    if not chaves_lista or not _garimpo_existem_fontes_xml_lote():
+        return []
+    ch_set = set()
+    for c in chaves_lista:
+        k = _chave44_digitos(c)
+        if k:
+            ch_set.add(k)
+    if not ch_set:
+        return []
+    usados = set()
+    ch44_ja_gravado = set()
+    out = []
+    for name, data, res, _ in _garimpo_iter_xml_lote(
+        cnpj_limpo, lambda r, _p: _chave44_digitos(r.get("Chave")) in ch_set
+    ):
+        ch44 = _chave44_digitos(res.get("Chave"))
+        if ch44 and ch44 in ch_set:
+            td = _tupla_dedupe_export_xml(res, ch44)
+            if td is None or td in ch44_ja_gravado:
+                del data
+                continue
+            ch44_ja_gravado.add(td)
+            arc = _nome_xml_raiz_zip_unico(usados, name)
+            out.append((arc, data, ch44, td))
         else:
-            xb_last = excel_bytes_relatorio_bloco(
-                df_filtrado_para_excel_bloco, Z["chaves_bloco"]
-            )
-        if xb_last:
-            if v2_zip_org and Z["z_org"] is not None and Z["org_count"] > 0:
-                Z["z_org"].writestr(excel_fn_last, xb_last)
-            if v2_zip_plano and Z["z_todos"] is not None and Z["todos_count"] > 0:
-                Z["z_todos"].writestr(excel_fn_last, xb_last)
+            del data
+    return out
 
-    if Z["z_org"] is not None:
+
+def escrever_zip_dominio_por_chaves(cnpj_limpo, chaves_lista, df_geral=None):
+    """Gera um ou mais ZIPs (máx. MAX_XML_PER_ZIP XMLs cada); XMLs na raiz; Excel do lote em RELATORIO_GARIMPEIRO/.
+    Devolve (lista_caminhos absolutos, total_xml, lista_flat) — lista_flat = [(arc, bytes, ch44, td), …] para descargas abertas."""
+    flat = _coletar_xmls_flat_dominio_por_chaves(cnpj_limpo, chaves_lista)
+    if not flat:
+        return [], 0, []
+    zip_dir = Path(TEMP_UPLOADS_DIR) / "export_zip_lista_especifica"
+    try:
+        zip_dir.mkdir(parents=True, exist_ok=True)
+    except OSError:
+        pass
+    run_stamp = f"{int(time.time() * 1000)}_{random.randint(1, 999999999)}"
+    parts = []
+    part_idx = 1
+    count_xml = len(flat)
+    i = 0
+    while i < len(flat):
+        chunk = flat[i : i + MAX_XML_PER_ZIP]
+        i += len(chunk)
+        nome = zip_dir / f"faltantes_dominio_final_pt{part_idx}_{run_stamp}.zip"
         try:
-            Z["z_org"].close()
+            abs_path = nome.resolve()
         except OSError:
-            pass
-    if Z["z_todos"] is not None:
+            abs_path = nome
+        zf = _zipfile_open_write_export(str(abs_path))
+        parts.append(str(abs_path))
+        chaves_excel_ordem = []
+        vistos_chave_excel = set()
         try:
-            Z["z_todos"].close()
-        except OSError:
-            pass
+            for arc, data, ch44, _td in chunk:
+                zf.writestr(arc, data)
+                if ch44 and ch44 not in vistos_chave_excel:
+                    vistos_chave_excel.add(ch44)
+                    chaves_excel_ordem.append(ch44)
+            _zip_anexar_excel_lista_especifica(
+                zf, df_geral, chaves_excel_ordem, part_idx
+            )
+        finally:
+            try:
+                zf.close()
+            except Exception:
+                pass
+        part_idx += 1
 
-    org_parts = Z["org_parts"]
-    todos_parts = Z["todos_parts"]
-    if v2_zip_org and Z["org_count"] == 0 and org_parts:
-        org_parts = []
-    if v2_zip_plano and Z["todos_count"] == 0 and todos_parts:
-        todos_parts = []
+    return parts, count_xml, flat
 
-    aviso = None
-    if (v2_zip_org or v2_zip_plano) and Z.get("xml_matched", 0) == 0:
-        aviso = (
-            "Nenhum XML em disco correspondeu às chaves. "
-            "Causas frequentes: pasta do garimpo apagada, ou chaves na tabela que não batem com os ficheiros."
-        )
-    return org_parts, todos_parts, Z["xml_matched"], aviso, None
+
+def _sped_c100_chave_nos_campos(parts: list, cod_mod: str) -> str:
+    """CHV_NFE (C100) ou CHV_CTE (D100): 44 dígitos nos campos típicos ou na linha."""
+    for idx in (9, 10, 11, 8):
+        if len(parts) <= idx:
+            continue
+        s = parts[idx].strip()
+        if len(s) == 44 and s.isdigit():
+            if not cod_mod or s[20:22] == cod_mod:
+                return s
+    linha = "|".join(parts)
+    cands = re.findall(r"\d{44}", linha)
+    if not cands:
+        return ""
+    if cod_mod and len(cod_mod) == 2:
+        for c in cands:
+            if c[20:22] == cod_mod:
+                return c
+    return cands[0]
 
 
-def _v2_export_zip_mariana(
-    df_geral: pd.DataFrame,
-    cnpj_limpo: str,
-    *,
-    zip_output_dir: Path,
-    zip_file_stem=None,
-):
+def _sped_registo_de_linha(line: str, n_lin: int):
+    """Tupla (Linha, REG_SPED, COD_MOD, SER, NUM_DOC, CHV_NFE, IND_OPER, IND_EMIT) de uma linha C100/D100, ou None."""
+    parts = line.split("|")
+    if len(parts) < 9:
+        return None
+    reg = (parts[1] or "").strip().upper()
+    if reg == "C100":
+        i_num = 8
+    elif reg == "D100" and len(parts) >= 10:
+        i_num = 9
+    else:
+        return None
+    cod_mod = parts[5].strip()
+    if not cod_mod:
+        return None
+    return (
+        n_lin,
+        reg,
+        cod_mod,
+        parts[7].strip(),
+        parts[i_num].strip(),
+        _sped_c100_chave_nos_campos(parts, cod_mod),
+        parts[2].strip(),
+        parts[3].strip(),
+    )
+
+
+def _sped_blocos_texto(fonte):
     """
-    Pacote contabilidade/matriz: **todo** o lote lido no garimpo (df_geral), **sem** filtros da Etapa 3.
-    ZIPs por grupo: **própria** `EP_ano_mes_Serie_…_Entrada|Saida_status_modelo`; **terceiros** `T_ano_mes_status_modelo`;
-    sufixo `_notas_min_max` nos .zip quando aplicável; dentro: `XML/Lote_001…` (10k/pasta) + Excel na raiz.
+    Texto do SPED em blocos terminados em fim de linha. `fonte` é o texto (str) ou o caminho do .txt:
+    o ficheiro é lido em blocos de `_SPED_BLOCO_LEITURA`, sem o carregar inteiro.
     """
-    nome = str(zip_file_stem or "").strip()
-    o, _t, xm, av, xls = _v2_export_zip_etapa3(
-        df_geral,
-        xml_respeita_filtro=False,
-        df_filtrado_para_excel_bloco=df_geral,
-        excel_um_so_completo=True,
-        df_excel_completo=df_geral,
-        v2_zip_org=True,
-        v2_zip_plano=False,
-        cnpj_limpo=cnpj_limpo,
-        zip_tag=None,
-        zip_output_dir=zip_output_dir,
-        zip_nome_ficheiro=nome,
-        pacote_pastas_garimpo=True,
-        pacote_pastas_contabilidade=True,
-        df_excel_todas_notas=df_geral,
-    )
-    return o, xm, av, xls
+    if isinstance(fonte, str):
+        yield fonte
+        return
+    with open(fonte, "rb") as fh:
+        resto = b""
+        while True:
+            b = fh.read(_SPED_BLOCO_LEITURA)
+            if not b:
+                break
+            b = resto + b
+            corte = b.rfind(b"\n") + 1
+            if corte == 0:
+                resto = b
+                continue
+            resto = b[corte:]
+            yield _decode_sped_upload_bytes(b[:corte])
+        if resto:
+            yield _decode_sped_upload_bytes(resto)
+
+
+def _sped_ler_c100_d100(fonte) -> dict:
+    """
+    Uma passagem pelo SPED: registos C100 (NF-e/NFC-e) e D100 (CT-e) numa tabela colunar, já sem repetidos
+    (C100 antes de D100; repetido = mesma chave 44 ou, sem chave, mesmo modelo+série+número) e o índice das
+    chaves 44.
+    Só as linhas que contêm «C100»/«D100» são partidas em campos; o resto do ficheiro é saltado pela regex.
+    """
+    regs = {"C100": [], "D100": []}
+    n_base = 1
+    for bloco in _sped_blocos_texto(fonte):
+        pos = 0
+        pos_lin = 0
+        n_lin = n_base
+        for m in _SPED_RE_C100_D100.finditer(bloco):
+            i = m.start()
+            if i < pos:
+                continue
+            ini = bloco.rfind("\n", 0, i) + 1
+            fim = bloco.find("\n", i)
+            if fim < 0:
+                fim = len(bloco)
+            n_lin += bloco.count("\n", pos_lin, ini)
+            pos_lin = ini
+            r = _sped_registo_de_linha(bloco[ini:fim].rstrip("\r"), n_lin)
+            if r is not None:
+                regs[r[1]].append(r)
+            pos = fim + 1
+        n_base = n_lin + bloco.count("\n", pos_lin)
 
+    visto = set()
+    linhas = []
+    chaves44 = []
+    for r in regs["C100"] + regs["D100"]:
+        ch = r[5]
+        valida = len(ch) == 44 and ch.isdigit()
+        k = ("K", ch) if valida else ("M", r[2], r[3], r[4])
+        if k in visto:
+            continue
+        visto.add(k)
+        linhas.append(r)
+        if valida:
+            chaves44.append(ch)
+    del regs, visto
+    df = pd.DataFrame(linhas, columns=list(_SPED_COLUNAS_REGISTOS))
+    df["Linha"] = df["Linha"].astype("int64")
+    chaves44 = list(dict.fromkeys(chaves44))
+    return {"regs": df, "chaves44": chaves44, "conj44": frozenset(chaves44)}
+
+
+def _sped_hash_fonte(fonte) -> str:
+    """SHA-256 do SPED (do ficheiro em blocos ou do texto). Para o da sessão usa o valor calculado ao guardar."""
+    if isinstance(fonte, str):
+        return hashlib.sha256(fonte.encode("utf-8", "surrogatepass")).hexdigest()
+    if str(_session_state_get_garimpo(SPED_SESSION_ARQUIVO_KEY) or "") == str(fonte):
+        h = _session_state_get_garimpo(SPED_SESSION_HASH_KEY)
+        if h:
+            return h
+    with open(fonte, "rb") as fh:
+        return _garimpo_sha256_origem(fh)
+
+
+def _sped_tabela(fonte) -> dict:
+    """
+    Tabela C100/D100 do SPED (`_sped_ler_c100_d100`), em cache pelo hash do ficheiro: na sessão (último SPED)
+    e em disco ao lado da cópia do .txt (`<sha256>.c100d100.pkl`), para o mesmo ficheiro não voltar a ser lido.
+    """
+    vazia = {"regs": pd.DataFrame(columns=list(_SPED_COLUNAS_REGISTOS)), "chaves44": [], "conj44": frozenset()}
+    if _sped_fonte_vazia(fonte):
+        return vazia
+    try:
+        h = _sped_hash_fonte(fonte)
+    except OSError:
+        return vazia
+    memo = _session_state_get_garimpo(SESSION_KEY_SPED_TABELA)
+    if isinstance(memo, dict) and memo.get("hash") == h:
+        return memo["tabela"]
+    p_cache = os.path.join(_sped_pasta_cache(), f"{h}.c100d100.pkl")
+    tab = None
+    try:
+        tab = pd.read_pickle(p_cache)
+    except Exception:
+        tab = None
+    if not isinstance(tab, dict) or "regs" not in tab:
+        try:
+            tab = _sped_ler_c100_d100(fonte)
+        except OSError:
+            return vazia
+        try:
+            os.makedirs(_sped_pasta_cache(), exist_ok=True)
+            tmp = p_cache + ".parcial"
+            pd.to_pickle(tab, tmp)
+            os.replace(tmp, p_cache)
+        except OSError:
+            pass
+    try:
+        st.session_state[SESSION_KEY_SPED_TABELA] = {"hash": h, "tabela": tab}
+    except Exception:
+        pass
+    return tab
 
-def _v2_uniq_sorted_str_series_vals(s: pd.Series) -> list:
-    return sorted(
-        {str(x) for x in s.tolist() if str(x) not in ("", "nan", "None")},
-        key=lambda x: (len(x), x),
-    )
 
+def _sped_chaves44_de_texto(texto) -> list:
+    """Chaves de 44 dígitos extraídas dos registos C100/D100 com CHV preenchida (texto ou ficheiro SPED)."""
+    return list(_sped_tabela(texto)["chaves44"])
 
-def v2_opcoes_cascata_etapa3(
-    df_base: pd.DataFrame,
-    filtro_origem: list,
-    filtro_tipos: list,
-    filtro_series: list,
-    filtro_status_labels: list,
-    filtro_operacao_labels: list,
-    filtro_data_modo_label: str,
-    filtro_data_d1,
-    filtro_data_d2,
-    filtro_faixa_modo_label: str,
-    filtro_faixa_n1: int,
-    filtro_faixa_n2: int,
-    filtro_ufs: list,
-    nota_esp_chave: str,
-    nota_esp_num: int,
-    nota_esp_serie: str,
-    terceiros_status_labels: list,
-    terceiros_tipos: list,
-    terceiros_operacao_labels: list,
-    terceiros_data_modo_label: str,
-    terceiros_data_d1,
-    terceiros_data_d2,
-) -> dict:
-    """Listas dependentes para Série e UF (só emissão própria), dados os outros filtros."""
-    empty = {"series": [], "ufs": []}
-    if df_base is None or df_base.empty:
-        return empty
 
-    def _series_em_propria(df):
-        if df is None or df.empty or "Série" not in df.columns:
-            return []
-        m = _mask_emissao_propria_df(df)
-        return _v2_uniq_sorted_str_series_vals(df.loc[m, "Série"].astype(str))
+# Texto do ficheiro SPED (.txt) na sessão (anexo no 1.º passo ao iniciar garimpo, ou no painel direito).
+# O ficheiro anexado é copiado para `_sped_pasta_cache()` e a sessão guarda só o caminho e o SHA-256
+# (`SPED_SESSION_ARQUIVO_KEY` / `SPED_SESSION_HASH_KEY`); o texto inteiro só fica na sessão se o disco falhar.
+SPED_SESSION_TEXT_KEY = "sped_efd_texto_sessao"
+SPED_SESSION_NAME_KEY = "sped_efd_nome_ficheiro_sessao"
+SPED_SESSION_ARQUIVO_KEY = "sped_efd_arquivo_sessao"
+SPED_SESSION_HASH_KEY = "sped_efd_sha256_sessao"
+SESSION_KEY_SPED_TABELA = "_sped_tabela_c100_d100"
+_SPED_BLOCO_LEITURA = 8 * 1024 * 1024
+_SPED_RE_C100_D100 = re.compile("C100|D100")
+_SPED_COLUNAS_REGISTOS = ("Linha", "REG_SPED", "COD_MOD", "SER", "NUM_DOC", "CHV_NFE", "IND_OPER", "IND_EMIT")
+# Relatório detalhado: chaves C100/D100 no SPED sem XML correspondente no lote lido.
+SPED_FALTANTES_XML_DF_KEY = "df_sped_faltantes_xml"
+SPED_FALTANTES_XLSX_PATH_KEY = "sped_faltantes_xlsx_caminho"
 
-    def _ufs_em_propria(df):
-        if df is None or df.empty or "UF Destino" not in df.columns:
-            return []
-        m = _mask_emissao_propria_df(df)
-        ser = df.loc[m, "UF Destino"].astype(str).str.upper().str.strip()
-        return sorted({x for x in ser.tolist() if x and x not in ("NAN", "NONE", "")})
 
-    d_ser = filtrar_df_geral_para_exportacao(
-        df_base,
-        filtro_origem,
-        filtro_tipos,
-        filtro_series,
-        filtro_status_labels,
-        filtro_operacao_labels,
-        filtro_data_modo_label,
-        filtro_data_d1,
-        filtro_data_d2,
-        filtro_faixa_modo_label,
-        filtro_faixa_n1,
-        filtro_faixa_n2,
-        filtro_ufs,
-        nota_esp_chave,
-        nota_esp_num,
-        nota_esp_serie,
-        terceiros_status_labels,
-        terceiros_tipos,
-        terceiros_operacao_labels,
-        terceiros_data_modo_label,
-        terceiros_data_d1,
-        terceiros_data_d2,
-        skip_filtro_serie=True,
-        skip_filtro_uf=False,
-        skip_nota_especifica=True,
-    )
-    d_uf = filtrar_df_geral_para_exportacao(
-        df_base,
-        filtro_origem,
-        filtro_tipos,
-        filtro_series,
-        filtro_status_labels,
-        filtro_operacao_labels,
-        filtro_data_modo_label,
-        filtro_data_d1,
-        filtro_data_d2,
-        filtro_faixa_modo_label,
-        filtro_faixa_n1,
-        filtro_faixa_n2,
-        filtro_ufs,
-        nota_esp_chave,
-        nota_esp_num,
-        nota_esp_serie,
-        terceiros_status_labels,
-        terceiros_tipos,
-        terceiros_operacao_labels,
-        terceiros_data_modo_label,
-        terceiros_data_d1,
-        terceiros_data_d2,
-        skip_filtro_serie=False,
-        skip_filtro_uf=True,
-        skip_nota_especifica=True,
-    )
-    return {
-        "series": _series_em_propria(d_ser),
-        "ufs": _ufs_em_propria(d_uf),
-    }
+def _decode_sped_upload_bytes(raw_b: bytes) -> str:
+    if not raw_b:
+        return ""
+    for enc in ("utf-8-sig", "utf-8", "latin-1", "cp1252"):
+        try:
+            return raw_b.decode(enc)
+        except UnicodeDecodeError:
+            continue
+    return raw_b.decode("latin-1", errors="replace")
 
 
-def v2_sanear_selecoes_contra_opcoes(series_opts: list, ufs_opts: list) -> None:
-    """Remove da sessão valores que deixaram de existir nas listas em cascata (série / UF)."""
-    for key, permitidos in (
-        ("v2_f_ser", set(series_opts)),
-        ("v2_f_uf", set(ufs_opts)),
-    ):
-        cur = list(st.session_state.get(key) or [])
-        novo = [x for x in cur if x in permitidos]
-        if novo != cur:
-            st.session_state[key] = novo
+def _sped_pasta_cache() -> str:
+    """Cópias dos SPED anexados e tabelas C100/D100 já lidas, por SHA-256 (partilhadas entre sessões)."""
+    return os.path.join(_garimpo_spool_raiz(), "sped")
 
 
-def _v2_remover_zips_em_disco_listados():
-    """Política: nunca apagar ficheiros exportados que o utilizador guardou em pasta."""
-    return
+def _sped_fonte_vazia(fonte) -> bool:
+    return fonte is None or (isinstance(fonte, str) and not fonte.strip())
 
 
-def _v2_limpar_estado_exportacao_etapa3(remover_zip_do_disco=True):
+def _sped_fonte_sessao():
     """
-    Reinicia sessão de downloads da Etapa 3.
-    Os ZIP no disco do utilizador **não são apagados** (política: só gravar).
-    remover_zip_do_disco mantido por compatibilidade; a remoção em disco está desativada.
+    SPED da sessão para `_sped_tabela` e afins: caminho (Path) do .txt guardado por `_sped_guardar_na_sessao`,
+    ou o texto (sessões antigas / disco indisponível); "" se não houver SPED.
     """
-    if remover_zip_do_disco:
-        _v2_remover_zips_em_disco_listados()
-    st.session_state["export_ready"] = False
-    st.session_state["org_zip_parts"] = []
-    st.session_state["todos_zip_parts"] = []
-    st.session_state["excel_buffer"] = None
-    st.session_state.pop("excel_buffer_propria", None)
-    st.session_state.pop("excel_buffer_terceiros", None)
-    st.session_state.pop("export_excel_name_propria", None)
-    st.session_state.pop("export_excel_name_terceiros", None)
-    st.session_state.pop("v2_export_sig", None)
-    st.session_state.pop("v2_export_sem_xml", None)
-    st.session_state["v2_etapa3_dual_export"] = False
-    st.session_state.pop("v2_export_lados", None)
-    st.session_state.pop("mariana_zip_parts", None)
-    st.session_state["mariana_export_ready"] = False
-    st.session_state.pop("mariana_export_sig", None)
-    st.session_state.pop("mariana_sem_xml_msg", None)
-    st.session_state.pop("mariana_excel_completo_path", None)
+    arq = _session_state_get_garimpo(SPED_SESSION_ARQUIVO_KEY)
+    if arq:
+        return Path(arq)
+    return str(_session_state_get_garimpo(SPED_SESSION_TEXT_KEY) or "").strip()
 
 
-def v2_assinatura_exportacao_sessao():
+def _sped_guardar_na_sessao(origem, nome: str) -> None:
     """
-    Identifica filtros + confirmação «exportar tudo» + formato (ZIP/Excel).
-    Se mudar após uma geração, os downloads guardados deixam de ser válidos.
+    Regista o SPED (UploadedFile, ficheiro aberto, bytes ou caminho) na sessão sem o decodificar: copia-o em blocos
+    para `_sped_pasta_cache()/<sha256>.txt` (um caminho já em disco, como na linha de comando, fica onde está) e
+    guarda caminho + hash. Se o disco falhar, o texto vai para `SPED_SESSION_TEXT_KEY`, como antes.
     """
-    return (
-        tuple(st.session_state.get("v2_f_orig") or []),
-        tuple(st.session_state.get("v2_f_tip") or []),
-        tuple(st.session_state.get("v2_f_ser") or []),
-        tuple(st.session_state.get("v2_f_stat") or []),
-        tuple(st.session_state.get("v2_f_op") or []),
-        tuple(st.session_state.get("v2_f_uf") or []),
-        str(st.session_state.get("v2_f_data_modo", "Qualquer")),
-        str(st.session_state.get("v2_f_data_d1", "")),
-        str(st.session_state.get("v2_f_data_d2", "")),
-        str(st.session_state.get("v2_f_faixa_modo", "Qualquer")),
-        int(st.session_state.get("v2_f_faixa_n1") or 0),
-        int(st.session_state.get("v2_f_faixa_n2") or 0),
-        str(st.session_state.get("v2_f_esp_chave", "")),
-        int(st.session_state.get("v2_f_esp_num") or 0),
-        str(st.session_state.get("v2_f_esp_ser", "")),
-        tuple(st.session_state.get("v2_t_stat") or []),
-        tuple(st.session_state.get("v2_t_tip") or []),
-        tuple(st.session_state.get("v2_t_op") or []),
-        str(st.session_state.get("v2_t_data_modo", "Qualquer")),
-        str(st.session_state.get("v2_t_data_d1", "")),
-        str(st.session_state.get("v2_t_data_d2", "")),
-        bool(st.session_state.get("v2_confirm_full", True)),
-        str(st.session_state.get("v2_export_format", "zip_tudo_pastas")),
+    origem_id = (
+        str(origem)
+        if isinstance(origem, (str, Path))
+        else getattr(origem, "file_id", None) or (nome, _garimpo_tamanho_origem(origem))
     )
+    arq_atual = _session_state_get_garimpo(SPED_SESSION_ARQUIVO_KEY)
+    if (
+        arq_atual
+        and _session_state_get_garimpo("_sped_origem_id") == origem_id
+        and os.path.isfile(arq_atual)
+    ):
+        return
+    caminho = h = None
+    try:
+        if isinstance(origem, (str, Path)):
+            caminho = os.path.abspath(origem)
+            with open(caminho, "rb") as fh:
+                h = _garimpo_sha256_origem(fh)
+        else:
+            pasta = _sped_pasta_cache()
+            os.makedirs(pasta, exist_ok=True)
+            tmp = os.path.join(pasta, f"{os.urandom(6).hex()}.parcial")
+            hs = hashlib.sha256()
+            try:
+                with open(tmp, "wb") as out_f:
+                    if isinstance(origem, (bytes, bytearray, memoryview)):
+                        hs.update(origem)
+                        out_f.write(origem)
+                    else:
+                        origem.seek(0)
+                        while True:
+                            b = origem.read(_SPED_BLOCO_LEITURA)
+                            if not b:
+                                break
+                            hs.update(b)
+                            out_f.write(b)
+                        origem.seek(0)
+                h = hs.hexdigest()
+                caminho = os.path.join(pasta, f"{h}.txt")
+                os.replace(tmp, caminho)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+        if os.path.getsize(caminho) == 0:
+            caminho = None
+    except OSError:
+        caminho = None
+    if caminho is None:
+        if isinstance(origem, (str, Path)):
+            try:
+                raw = Path(origem).read_bytes()
+            except OSError:
+                raw = b""
+        elif isinstance(origem, (bytes, bytearray, memoryview)):
+            raw = bytes(origem)
+        else:
+            origem.seek(0)
+            raw = origem.read()
+            origem.seek(0)
+        st.session_state[SPED_SESSION_TEXT_KEY] = _decode_sped_upload_bytes(raw).strip()
+        st.session_state.pop(SPED_SESSION_ARQUIVO_KEY, None)
+        st.session_state.pop(SPED_SESSION_HASH_KEY, None)
+    else:
+        st.session_state[SPED_SESSION_ARQUIVO_KEY] = caminho
+        st.session_state[SPED_SESSION_HASH_KEY] = h
+        st.session_state.pop(SPED_SESSION_TEXT_KEY, None)
+    st.session_state["_sped_origem_id"] = origem_id
+    st.session_state[SPED_SESSION_NAME_KEY] = nome
 
 
-def v2_assinatura_pacote_matriz_sessao(df_geral):
-    """
-    Pacote contabilidade / matriz: **não** inclui filtros da Etapa 3.
-    Invalida ao mudar o relatório geral (novo garimpo), pasta/nome do ZIP ou CNPJ na sessão.
-    """
-    return (
-        id(df_geral) if df_geral is not None else 0,
-        str(st.session_state.get("mariana_zip_save_dir") or ""),
-        str(st.session_state.get("mariana_zip_basename") or ""),
-        str(st.session_state.get("cnpj_widget") or ""),
-    )
+def _sped_resolver_fonte_de_uploader(upload_widget):
+    """Prioridade: ficheiro anexado no widget; senão o SPED já importado para a sessão (`_sped_fonte_sessao`)."""
+    if upload_widget is not None:
+        _sped_guardar_na_sessao(upload_widget, getattr(upload_widget, "name", None) or "SPED.txt")
+    return _sped_fonte_sessao()
 
 
-def v2_callback_repor_filtros():
-    """Limpa multiselects da Etapa 3. Deve ser usado com on_click (antes dos widgets na mesma corrida)."""
-    for _kx in (
-        "v2_f_orig",
-        "v2_f_tip",
-        "v2_f_ser",
-        "v2_f_stat",
-        "v2_f_op",
-        "v2_f_uf",
-        "v2_t_stat",
-        "v2_t_tip",
-        "v2_t_op",
-    ):
-        st.session_state[_kx] = []
-    st.session_state["v2_f_data_modo"] = "Qualquer"
-    st.session_state["v2_f_faixa_modo"] = "Qualquer"
-    st.session_state["v2_f_faixa_n1"] = 0
-    st.session_state["v2_f_faixa_n2"] = 0
-    st.session_state.pop("v2_f_data_d1", None)
-    st.session_state.pop("v2_f_data_d2", None)
-    st.session_state["v2_f_esp_chave"] = ""
-    st.session_state["v2_f_esp_num"] = 0
-    st.session_state["v2_f_esp_ser"] = ""
-    st.session_state["v2_t_data_modo"] = "Qualquer"
-    st.session_state.pop("v2_t_data_d1", None)
-    st.session_state.pop("v2_t_data_d2", None)
-    st.session_state["v2_export_format"] = "zip_tudo_pastas"
-    _v2_limpar_estado_exportacao_etapa3()
-    st.session_state.pop("_v2_e3_preview_dis_cache", None)
+def _garimpo_tem_sped_no_inicio_grand_garimpo() -> bool:
+    """SPED no 1.º passo: já na sessão ou ficheiro anexado no widget antes de «Iniciar grande garimpo»."""
+    if not _sped_fonte_vazia(_sped_fonte_sessao()):
+        return True
+    w = st.session_state.get("sped_sessao_upload_ini")
+    if w is None:
+        return False
+    try:
+        w.seek(0)
+        try:
+            while True:
+                b = w.read(_SPED_BLOCO_LEITURA)
+                if not b:
+                    return False
+                if b.strip():
+                    return True
+        finally:
+            w.seek(0)
+    except Exception:
+        return False
 
 
-def rotulo_download_zip_parte(caminho_ficheiro):
-    base = os.path.basename(caminho_ficheiro)
-    m = re.search(r"pt(\d+)\.zip$", base, re.I)
-    if m:
-        return f"ZIP — parte {m.group(1)}"
-    if "__" in base and base.lower().endswith(".zip"):
-        return base[:-4].split("__", 1)[-1]
-    if base.lower().endswith(".zip"):
-        return base[:-4]
-    return base
+def _garimpo_escrita_espelho_final_continua_ativa() -> bool:
+    """
+    Há pasta de espelho **Garimpeiro_Local_*** definida (PC / servidor próprio).
+    Durante o ciclo de leitura **não** se grava o pacote em disco (só memória / temp).
+    A gravação do espelho corre **uma vez**, no **segundo** render do ecrã de resultados
+    (primeiro mostra só o relatório; depois `st.rerun` grava o ZIP na pasta).
+    Na Community Cloud fica desligado.
+    """
+    if _streamlit_likely_community_cloud():
+        return False
+    return bool(str(st.session_state.get("garimpo_lote_espelho_root") or "").strip())
 
 
-def enumerar_buracos_por_segmento(nums_sorted, tipo_doc, serie_str, gap_max=MAX_SALTO_ENTRE_NOTAS_CONSECUTIVAS):
-    """Buracos só dentro de cada trecho; saltos grandes quebram o trecho (não preenche o intervalo entre faixas)."""
-    out = []
-    if not nums_sorted:
-        return out
-    segmentos = [[nums_sorted[0]]]
-    for i in range(1, len(nums_sorted)):
-        if nums_sorted[i] - nums_sorted[i - 1] > gap_max:
-            segmentos.append([nums_sorted[i]])
-        else:
-            segmentos[-1].append(nums_sorted[i])
-    for seg in segmentos:
-        lo, hi = seg[0], seg[-1]
-        seg_set = set(seg)
-        for b in range(lo, hi + 1):
-            if b not in seg_set:
-                out.append({"Tipo": tipo_doc, "Série": serie_str, "Num_Faltante": b})
-    return out
+def _garimpo_hidratar_sped_sessao_do_widget_ini() -> None:
+    """Antes da leitura em ciclo: copia o SPED do widget do 1.º passo para a sessão."""
+    _sped_u_ini = st.session_state.get("sped_sessao_upload_ini")
+    if _sped_u_ini is None:
+        return
+    try:
+        _sped_guardar_na_sessao(_sped_u_ini, getattr(_sped_u_ini, "name", None) or "SPED.txt")
+    except Exception:
+        pass
 
 
-_CHAVE_44_RE = re.compile(r"\d{44}")
+def _dataframe_sped_chaves_sem_xml_no_lote(texto_sped, matched_ch: set) -> pd.DataFrame:
+    """Uma linha por chave de 44 dígitos presente no SPED (C100/D100) e não encontrada no lote (sem XML cruzado)."""
+    regs = _sped_tabela(texto_sped)["regs"]
+    cols = ["Chave", "REG_SPED", "COD_MOD", "Serie", "NUM_DOC", "Linha_SPED", "Motivo"]
+    if regs.empty:
+        return pd.DataFrame(columns=cols)
+    ch = regs["CHV_NFE"]
+    m = (ch.str.len() == 44) & ch.str.isdigit() & ~ch.isin(matched_ch or ())
+    df = regs.loc[m].drop_duplicates("CHV_NFE")
+    if df.empty:
+        return pd.DataFrame(columns=cols)
+    return pd.DataFrame(
+        {
+            "Chave": df["CHV_NFE"].to_numpy(),
+            "REG_SPED": df["REG_SPED"].to_numpy(),
+            "COD_MOD": df["COD_MOD"].to_numpy(),
+            "Serie": df["SER"].to_numpy(),
+            "NUM_DOC": df["NUM_DOC"].to_numpy(),
+            "Linha_SPED": df["Linha"].to_numpy(),
+            "Motivo": "Consta no SPED (C100/D100); sem XML correspondente no lote atual",
+        }
+    )
 
 
-def _celula_extra_chaves_acesso_44(val):
-    """Extrai uma ou mais sequências de 44 dígitos de uma célula (texto ou número)."""
-    out = []
-    if val is None or (isinstance(val, float) and pd.isna(val)):
-        return out
-    if isinstance(val, (int, float)) and not isinstance(val, bool):
+def _extrair_pares_xml_intersecao_sped_lote(cnpj_limpo: str, texto_sped):
+    """
+    XML do lote cuja chave 44 está em C100/D100 do SPED.
+    Devolve (lista [(nome_arquivo, bytes)], matched_chaves_44, chaves_sped_44, erros_amostra).
+    """
+    chaves_ord = _sped_chaves44_de_texto(texto_sped)
+    ch_set = set(chaves_ord)
+    if not ch_set:
+        return [], set(), set(), []
+    cnpj = "".join(c for c in str(cnpj_limpo or "") if c.isdigit())[:14]
+    usados_nomes = set()
+    ch44_ja_gravado = set()
+    matched_ch = set()
+    pairs = []
+    erros = []
+    for name, data, res, _ in _garimpo_iter_xml_lote(
+        cnpj, lambda r, _p: _chave44_digitos(r.get("Chave")) in ch_set
+    ):
         try:
-            f = float(val)
-            s = str(int(f)) if f.is_integer() else str(val).strip()
-        except (ValueError, OverflowError):
-            s = str(val).strip()
-    else:
-        s = str(val).strip()
-    if not s:
-        return out
-    out.extend(_CHAVE_44_RE.findall(s))
-    digitos = "".join(filter(str.isdigit, s))
-    if len(digitos) >= 44:
-        bl = digitos[:44]
-        if bl not in out:
-            out.append(bl)
-    return out
+            ch44 = _chave44_digitos(res.get("Chave"))
+            if ch44 and ch44 in ch_set:
+                td = _tupla_dedupe_export_xml(res, ch44)
+                if td is None or td in ch44_ja_gravado:
+                    continue
+                ch44_ja_gravado.add(td)
+                arc = _nome_xml_raiz_zip_unico(usados_nomes, name)
+                raw = data if isinstance(data, (bytes, bytearray)) else bytes(data)
+                pairs.append((arc, raw))
+                matched_ch.add(ch44)
+        except OSError as e:
+            erros.append(str(e))
+        finally:
+            del data
+    return pairs, matched_ch, ch_set, erros
 
 
-def _scan_dataframe_chaves_44(df: pd.DataFrame) -> list:
-    """Percorre colunas; prioriza cabeçalhos com «chave» / «acesso»."""
+def _excel_bytes_dataframe_simples(df: pd.DataFrame, sheet: str = "SPED_sem_XML") -> bytes | None:
     if df is None or df.empty:
-        return []
-    cols = list(df.columns)
-    pref = []
-    for c in cols:
-        cn = str(c).strip().lower().replace("_", " ")
-        if "chave" in cn.replace(" ", "") or "acesso" in cn or cn == "key":
-            pref.append(c)
-    ordem = pref + [c for c in cols if c not in pref]
-    chaves_ord = []
-    seen = set()
-    for c in ordem:
-        for val in df[c]:
-            for ch in _celula_extra_chaves_acesso_44(val):
-                if ch not in seen:
-                    seen.add(ch)
-                    chaves_ord.append(ch)
-    return chaves_ord
+        return None
+    try:
+        buf = io.BytesIO()
+        with pd.ExcelWriter(buf, engine="openpyxl") as w:
+            df.to_excel(w, sheet_name=sheet[:31], index=False)
+        return buf.getvalue()
+    except Exception:
+        return None
 
 
-def extrair_chaves_de_planilha(arquivo_upload):
-    """
-    Lê Excel (.xlsx, .xls) ou CSV com chaves de 44 dígitos.
-    Procura coluna «Chave» (ou equivalente) e, em qualquer caso, todas as células.
-    Tenta 1.ª linha como cabeçalho; se não encontrar chaves, tenta sem cabeçalho.
-    """
-    if arquivo_upload is None:
-        return []
-    raw = arquivo_upload.read()
+def _garimpo_pastas_candidatas_excel_sped_faltantes():
+    """Pastas onde tentar gravar o Excel (preferência: pasta indicada no 1.º passo → pai do espelho → dados da app)."""
+    candidatas = []
+    vistos = set()
+
+    def _add(caminho):
+        if caminho is None:
+            return
+        try:
+            p = Path(str(caminho).strip()).expanduser().resolve()
+            if p in vistos:
+                return
+            vistos.add(p)
+            candidatas.append(p)
+        except (OSError, ValueError):
+            pass
+
+    _add(st.session_state.get("garimpo_lote_save_resolved"))
+    _esp = st.session_state.get("garimpo_lote_espelho_root")
+    if _esp:
+        try:
+            _add(Path(str(_esp).strip()).expanduser().resolve().parent)
+        except (OSError, ValueError):
+            pass
     try:
-        arquivo_upload.seek(0)
+        _add(Path(_GARIM_ROOT) / "SPED_relatorio_lote")
     except Exception:
         pass
-    nome = (getattr(arquivo_upload, "name", "") or "").lower()
+    try:
+        _add(Path(TEMP_UPLOADS_DIR) / "relatorios_sped")
+    except Exception:
+        pass
+    return candidatas
 
-    def read_df(header):
-        if nome.endswith(".csv"):
-            for enc in ("utf-8-sig", "utf-8", "cp1252", "latin-1"):
-                try:
-                    return pd.read_csv(
-                        io.BytesIO(raw),
-                        sep=None,
-                        engine="python",
-                        encoding=enc,
-                        header=header,
-                    )
-                except Exception:
-                    continue
-            return None
-        try:
-            return pd.read_excel(io.BytesIO(raw), header=header)
-        except Exception:
-            return None
 
-    for header in (0, None):
-        df = read_df(header)
-        if df is None or df.empty:
+def _garimpo_gravar_excel_sped_faltantes_em_pasta_utilizador(df: pd.DataFrame) -> Path | None:
+    """
+    Grava sempre que possível `SPED_chaves_sem_XML_no_lote.xlsx` numa pasta persistente.
+    Devolve o caminho completo do ficheiro gravado ou None.
+    """
+    if df is None or getattr(df, "empty", True):
+        return None
+    b = _excel_bytes_dataframe_simples(df, sheet="Faltantes_SPED")
+    if not b:
+        return None
+    nome = "SPED_chaves_sem_XML_no_lote.xlsx"
+    for pasta in _garimpo_pastas_candidatas_excel_sped_faltantes():
+        try:
+            pasta.mkdir(parents=True, exist_ok=True)
+            p = pasta / nome
+            with open(p, "wb") as wf:
+                wf.write(b)
+            return p.resolve()
+        except OSError:
             continue
-        keys = _scan_dataframe_chaves_44(df)
-        if keys:
-            return keys
-    return []
-
+    return None
 
-def extrair_chaves_de_excel(arquivo_excel):
-    """Nome legado — mesmo que extrair_chaves_de_planilha."""
-    return extrair_chaves_de_planilha(arquivo_excel)
 
+def _pasta_destino_sped_xml_para_gravar():
+    """Resolve pasta em session_state['sped_xml_dest_dir'] (caminho completo obrigatório)."""
+    raw = st.session_state.get("sped_xml_dest_dir")
+    s = (str(raw).strip().strip('"').strip("'") if raw is not None else "")
+    if not s:
+        return (
+            None,
+            "Indique a **pasta completa** onde gravar os XML (o campo não pode ficar em branco).",
+        )
+    _ew = _erro_caminho_windows_num_servidor_nao_windows(s)
+    if _ew:
+        return None, _ew
+    try:
+        p = Path(s).expanduser().resolve()
+    except (OSError, ValueError):
+        return None, "Caminho inválido. Use um caminho completo (ex.: D:\\Exportacoes\\XML_SPED)."
+    if p.exists() and not p.is_dir():
+        return (
+            None,
+            "Esse caminho já existe e não é uma pasta (é um ficheiro). Escolha outra pasta.",
+        )
+    try:
+        p.mkdir(parents=True, exist_ok=True)
+    except OSError as e:
+        return None, f"Não foi possível criar ou aceder à pasta: {e}"
+    return p, None
 
-_MAX_FAIXA_EXPORT_DOM = 5000  # Máx. largura de faixa por linha (lista específica / inutilizadas)
 
+def gravar_xml_lote_filtrado_por_chaves_sped(cnpj_limpo: str, texto_sped, pasta_dest: Path):
+    """
+    Grava na pasta_dest os XML do lote atual cuja chave 44 consta em C100/D100 do SPED (campo CHV).
+    Devolve (n_ficheiros_gravados, n_chaves_sped_sem_xml_no_lote, mensagem_markdown).
+    """
+    if _sped_fonte_vazia(texto_sped):
+        return 0, 0, "Ficheiro SPED vazio."
+    chaves_ord = _sped_chaves44_de_texto(texto_sped)
+    ch_set = set(chaves_ord)
+    if not ch_set:
+        return (
+            0,
+            0,
+            "Nenhuma chave de 44 dígitos encontrada nos blocos C100/D100 (confirme que o .txt é EFD ICMS/IPI e tem CHV).",
+        )
+    if not _garimpo_existem_fontes_xml_lote():
+        return (
+            0,
+            len(ch_set),
+            "Não há XML do lote em memória/pasta — faça o **garimpo** primeiro e mantenha os ficheiros acessíveis.",
+        )
 
-def _excel_celula_int(val):
-    if val is None or (isinstance(val, float) and pd.isna(val)):
-        return None
-    if isinstance(val, str):
-        s = val.strip()
-        if not s:
-            return None
-        try:
-            return int(float(s.replace(",", ".")))
-        except ValueError:
-            return None
+    pairs, matched_ch, ch_set, erros = _extrair_pares_xml_intersecao_sped_lote(
+        cnpj_limpo, texto_sped
+    )
+    count = 0
     try:
-        return int(float(val))
-    except (TypeError, ValueError):
-        return None
-
+        pasta_dest.mkdir(parents=True, exist_ok=True)
+    except OSError as e:
+        return 0, len(ch_set), f"Não foi possível usar a pasta: {e}"
 
-def _excel_celula_serie(val):
-    if val is None or (isinstance(val, float) and pd.isna(val)):
-        return ""
-    if isinstance(val, (int, float)) and not isinstance(val, bool):
+    for arc, raw in pairs:
         try:
-            f = float(val)
-            if f.is_integer():
-                return str(int(f))
-        except (ValueError, OverflowError):
-            pass
-    return str(val).strip()
+            dest = pasta_dest / arc
+            with open(dest, "wb") as wf:
+                wf.write(raw if isinstance(raw, (bytes, bytearray)) else bytes(raw))
+            count += 1
+        except OSError as e:
+            erros.append(str(e))
 
+    n_falt_sped = len(ch_set - matched_ch)
+    msg = (
+        f"Gravados **{count}** ficheiro(s) em `{pasta_dest}`. "
+        f"No SPED (C100/D100): **{len(ch_set)}** chave(s) de 44 dígitos; "
+        f"com XML no lote e gravadas: **{len(matched_ch)}**."
+    )
+    if n_falt_sped:
+        msg += f" **{n_falt_sped}** chave(s) do SPED **sem** ficheiro correspondente no lote atual."
+    if erros:
+        msg += f" Erros ao gravar (amostra): {erros[:3]}"
+    return count, n_falt_sped, msg
 
-def _coluna_por_palavras(nomes_cols, palavras, ja_usados):
-    """Índice da primeira coluna cujo nome contém alguma palavra-chave (não em ja_usados)."""
-    for i, nome in enumerate(nomes_cols):
-        if i in ja_usados:
-            continue
-        c = str(nome).strip().lower().replace("_", " ")
-        comp = c.replace(" ", "")
-        for p in palavras:
-            p2 = p.lower().replace(" ", "")
-            if p2 in comp or p.lower() in c:
-                return i
-    return None
+
+def _zip_bytes_from_arc_pairs(pairs: list) -> bytes:
+    """Um único .zip em memória a partir de [(nome_interno, bytes), …]."""
+    if not pairs:
+        return b""
+    buf = io.BytesIO()
+    with zipfile.ZipFile(
+        buf,
+        "w",
+        zipfile.ZIP_DEFLATED,
+        compresslevel=_zip_export_compresslevel(),
+    ) as zf:
+        for arc, raw in pairs:
+            zf.writestr(arc, raw if isinstance(raw, (bytes, bytearray)) else bytes(raw))
+    return buf.getvalue()
 
 
-def extrair_faixas_ini_fim_serie_excel(arquivo_excel):
-    """
-    Planilha com numeração inicial, final e série (3 colunas).
-    Aceita cabeçalhos em português ou dados nas colunas A, B, C sem título.
-    Retorno: (lista de dicts n_ini, n_fim, serie, linhas_ignoradas, mensagem_erro).
-    """
+def _intervalo_mes_relatorio(ano, mes):
     try:
-        df = pd.read_excel(arquivo_excel)
-    except Exception:
-        return [], 0, "Não foi possível ler o ficheiro Excel."
+        a, m = int(ano), int(mes)
+        if a < 1900 or not (1 <= m <= 12):
+            return None, None
+        d1 = date(a, m, 1)
+        d2 = date(a, m, monthrange(a, m)[1])
+        return d1, d2
+    except (TypeError, ValueError):
+        return None, None
 
-    if df is None or df.empty:
-        return [], 0, "Planilha vazia."
 
-    nomes = list(df.columns)
-    lowered = [str(x).strip().lower() for x in nomes]
+def _data_emissao_linha(row):
+    de = row.get("Data Emissão")
+    if de is not None and not (isinstance(de, float) and pd.isna(de)):
+        s = str(de).strip()[:10]
+        if len(s) >= 10 and s[4] == "-" and s[7] == "-":
+            try:
+                return date.fromisoformat(s[:10])
+            except ValueError:
+                pass
+    return None
 
-    i_ini = _coluna_por_palavras(
-        lowered,
-        [
-            "numeracao inicial",
-            "numeração inicial",
-            "nota inicial",
-            "n inicial",
-            "inicial",
-            "inicio",
-            "início",
-        ],
-        set(),
-    )
-    i_fim = _coluna_por_palavras(
-        lowered,
-        [
-            "numeracao final",
-            "numeração final",
-            "nota final",
-            "n final",
-            "final",
-            "fim",
-            "até",
-            "ate",
-        ],
-        {i_ini} if i_ini is not None else set(),
-    )
-    _us_ser = set()
-    if i_ini is not None:
-        _us_ser.add(i_ini)
-    if i_fim is not None:
-        _us_ser.add(i_fim)
-    i_ser = _coluna_por_palavras(
-        lowered,
-        ["serie", "série", "ser"],
-        _us_ser,
-    )
 
-    if i_ini is None or i_fim is None or i_ser is None:
-        if len(nomes) >= 3:
-            i_ini, i_fim, i_ser = 0, 1, 2
-        else:
-            return (
-                [],
-                0,
-                "Indique 3 colunas (inicial, final, série) ou use cabeçalhos reconhecíveis.",
-            )
+def _linha_no_periodo(row, d_ini, d_fim):
+    d0 = _data_emissao_linha(row)
+    if d0 is not None:
+        return d_ini <= d0 <= d_fim
+    lo, hi = _intervalo_mes_relatorio(row.get("Ano"), row.get("Mes"))
+    if lo is None:
+        return False
+    return not (hi < d_ini or lo > d_fim)
 
-    c_ini, c_fim, c_ser = nomes[i_ini], nomes[i_fim], nomes[i_ser]
-    faixas = []
-    ignoradas = 0
 
-    for _, row in df.iterrows():
-        n0 = _excel_celula_int(row[c_ini])
-        n1 = _excel_celula_int(row[c_fim])
-        ser = _excel_celula_serie(row[c_ser])
-        if n0 is None or n1 is None or not ser:
-            ignoradas += 1
-            continue
-        if n0 > n1:
-            n0, n1 = n1, n0
-        if (n1 - n0 + 1) > _MAX_FAIXA_EXPORT_DOM:
-            ignoradas += 1
-            continue
-        faixas.append({"n_ini": n0, "n_fim": n1, "serie": ser})
+def _chave44_de_linha(row):
+    ch = row.get("Chave")
+    if ch is None or (isinstance(ch, float) and pd.isna(ch)):
+        return None
+    s = "".join(filter(str.isdigit, str(ch)))
+    if len(s) >= 44:
+        return s[:44]
+    return None
 
-    if not faixas:
-        msg = "Nenhuma linha válida."
-        if ignoradas:
-            msg += f" ({ignoradas} linha(s) ignorada(s): vazias, série em falta ou faixa acima de {_MAX_FAIXA_EXPORT_DOM} notas.)"
-        return [], ignoradas, msg
 
-    return faixas, ignoradas, None
+def _chave_para_conjunto_export(ch):
+    """
+    Normaliza Chave para cruzar df_geral com identify_xml_info ao gerar ZIPs (Etapa 3).
+    Evita falhas por float/.0 na coluna, notação científica parcial ou espaços — casos em que
+    `res['Chave'] in set(df['Chave'])` nunca era verdadeiro.
+    """
+    if ch is None:
+        return None
+    try:
+        if pd.isna(ch):
+            return None
+    except (TypeError, ValueError):
+        pass
+    t = str(ch).strip()
+    if not t or t.lower() == "nan":
+        return None
+    if t.startswith("INUT_"):
+        return t
+    d = "".join(filter(str.isdigit, t))
+    if len(d) >= 44:
+        return d[:44]
+    return None
 
 
-_MAX_CHAVES_EXCEL_FAIXAS = 75000  # Limite de chaves agregadas por planilha (várias linhas)
+def _v2_extrai_chaves_44_do_texto(chave_raw: str) -> list:
+    """Blocos de exatamente 44 dígitos seguidos (como no menu do Garimpeiro Raiz)."""
+    if not chave_raw or not str(chave_raw).strip():
+        return []
+    brutas = re.findall(r"\d{44}", str(chave_raw))
+    visto, chaves = set(), []
+    for c in brutas:
+        if c not in visto:
+            visto.add(c)
+            chaves.append(c)
+    return chaves
 
 
-def chaves_agregadas_de_excel_faixas(df_geral, faixas_lista, modelo):
-    """Cruza cada faixa com o relatório geral; devolve (chaves únicas, cortado_por_limite)."""
-    if df_geral is None or df_geral.empty or not faixas_lista:
-        return [], False
-    vistos = set()
-    ordenadas = []
-    for fx in faixas_lista:
-        ch_sub = chaves_por_faixa_numeracao(
-            df_geral,
-            modelo,
-            fx["serie"],
-            fx["n_ini"],
-            fx["n_fim"],
-        )
-        for ch in ch_sub:
-            if ch not in vistos:
-                vistos.add(ch)
-                ordenadas.append(ch)
-                if len(ordenadas) >= _MAX_CHAVES_EXCEL_FAIXAS:
-                    return ordenadas, True
-    return ordenadas, False
+def _v2_aplicar_nota_especifica_propria(
+    out_p: pd.DataFrame,
+    chave_raw,
+    numero_esp,
+    serie_raw,
+    *,
+    skip: bool = False,
+) -> pd.DataFrame:
+    """Restringe a chave(s) de 44 dígitos, INUT_… ou n.º + série (emissão própria ou terceiros)."""
+    if skip or out_p is None or out_p.empty or "Chave" not in out_p.columns:
+        return out_p
+    ch_raw = str(chave_raw or "")
+    ch_st = ch_raw.strip()
 
+    chaves_44 = _v2_extrai_chaves_44_do_texto(ch_st)
+    ch_d_all = "".join(c for c in ch_st if c.isdigit())
+    if not chaves_44 and len(ch_d_all) >= 44:
+        chaves_44 = [ch_d_all[:44]]
 
-def _nome_xml_raiz_zip_unico(usados, nome_arquivo):
-    """Nome dentro do ZIP só na raiz; evita colisão se houver ficheiros homónimos."""
-    base = os.path.basename(str(nome_arquivo).replace("\\", "/"))
-    if not base or base in (".", ".."):
-        base = "documento.xml"
-    if base not in usados:
-        usados.add(base)
-        return base
-    stem, ext = os.path.splitext(base)
-    if not ext:
-        ext = ".xml"
-    k = 2
-    while True:
-        cand = f"{stem}_{k}{ext}"
-        if cand not in usados:
-            usados.add(cand)
-            return cand
-        k += 1
+    if len(chaves_44) >= 1:
+        conj = set(chaves_44)
+        ck_norm = out_p["Chave"].map(_chave_para_conjunto_export)
+        return out_p.loc[ck_norm.isin(conj)]
 
+    inuts = []
+    for line in ch_raw.splitlines():
+        lu = line.strip().upper()
+        if lu.startswith("INUT_") and len(lu) > 5:
+            inuts.append(lu)
+    inuts = list(dict.fromkeys(inuts))
+    if len(inuts) == 1:
+        return out_p.loc[out_p["Chave"].astype(str).str.strip().str.upper() == inuts[0]]
+    if len(inuts) > 1:
+        sset = set(inuts)
+        ck = out_p["Chave"].astype(str).str.strip().str.upper()
+        return out_p.loc[ck.isin(sset)]
 
-def _chave44_digitos(ch):
-    d = "".join(filter(str.isdigit, str(ch or "")))
-    if len(d) >= 44:
-        return d[:44]
-    return None
+    try:
+        n = int(numero_esp)
+    except (TypeError, ValueError):
+        n = 0
+    ser = str(serie_raw or "").strip()
+    if ser and n > 0 and "Nota" in out_p.columns and "Série" in out_p.columns:
+        nn = pd.to_numeric(out_p["Nota"], errors="coerce")
+        ser_col = out_p["Série"].astype(str).str.strip()
+        mask = (nn == n) & (ser_col == ser)
+        if not mask.any() and ser.isdigit():
+            mask = (nn == n) & (pd.to_numeric(ser_col, errors="coerce") == int(ser))
+        return out_p.loc[mask]
+    return out_p
 
 
-def _chaves_lista_do_df(df):
-    """Chaves NFe 44 dígitos únicas, por ordem de aparição."""
-    if df is None or df.empty or "Chave" not in df.columns:
-        return []
-    out = []
-    for v in df["Chave"].tolist():
-        k = _chave44_digitos(v)
-        if k:
-            out.append(k)
-    return list(dict.fromkeys(out))
+def _nota_int_linha(row):
+    return _nota_int_valor(row.get("Nota"))
 
 
-def _df_sig_hash_memo(df):
-    if df is None or df.empty:
-        return "empty"
+def _nota_int_valor(n):
+    if n is None or (isinstance(n, float) and pd.isna(n)):
+        return None
     try:
-        h = pd.util.hash_pandas_object(df.reset_index(drop=True), index=True)
-        return hashlib.md5(h.values.tobytes()).hexdigest()
-    except Exception:
-        return hashlib.md5(
-            f"{len(df)}|{list(df.columns)}".encode("utf-8", errors="replace")
-        ).hexdigest()
+        return int(n)
+    except (ValueError, TypeError):
+        try:
+            return int(float(n))
+        except (ValueError, TypeError):
+            return None
 
 
-def _excel_bytes_memo(prefix, df_work, sheet_name):
-    """
-    Gera bytes Excel só quando o DataFrame filtrado muda — evita recalcular a cada clique
-    noutros widgets (menos RAM e menos tempo na zona de relatório / Etapa 3).
-    """
-    if df_work is None or df_work.empty:
-        st.session_state.pop(f"_xlsx_mem_{prefix}", None)
-        return None
-    sig = _df_sig_hash_memo(df_work)
-    sk = f"_xlsx_mem_{prefix}"
-    prev = st.session_state.get(sk)
-    if isinstance(prev, tuple) and prev[0] == sig:
-        return prev[1]
-    df_ex = (
-        _df_com_data_emissao_dd_mm_yyyy(df_work.copy())
-        if "Data Emissão" in df_work.columns
-        else df_work.copy()
-    )
-    b = dataframe_para_excel_bytes(df_ex, sheet_name)
-    if b is not None:
-        st.session_state[sk] = (sig, b)
-    else:
-        st.session_state.pop(sk, None)
-    return b
+# CÃ³digo <mod> da Sefaz â†’ rótulo usado na coluna Modelo do relatório geral
+_MODELO_SEFAZ_PARA_RELATORIO = {
+    "55": "NF-e",
+    "65": "NFC-e",
+    "57": "CT-e",
+    "58": "MDF-e",
+    "67": "CT-e OS",
+}
 
 
-def _relatorio_leitura_tabela_aggrid(df_raw: pd.DataFrame, grid_key: str, height: int = 420):
-    """
-    Grelha Ag-Grid: filtro e ordenação no cabeçalho de cada coluna (comportamento próximo do Excel).
-    Devolve o DataFrame original (`df_raw`) restrito às linhas visíveis após filtro/ordenação,
-    para Excel e ZIP XML.
-    """
-    if df_raw is None or df_raw.empty:
-        return df_raw
+def _normaliza_modelo_filtro(modelo):
+    """Aceita NF-e, NFC-e… ou 55, 65… (código Sefaz) para cruzar com df_geral."""
+    if modelo is None:
+        return ""
+    s = str(modelo).strip()
+    if not s:
+        return ""
+    if s in _MODELO_SEFAZ_PARA_RELATORIO:
+        return _MODELO_SEFAZ_PARA_RELATORIO[s]
+    try:
+        k = str(int(float(s.replace(",", "."))))
+        if k in _MODELO_SEFAZ_PARA_RELATORIO:
+            return _MODELO_SEFAZ_PARA_RELATORIO[k]
+    except (ValueError, TypeError):
+        pass
+    return s
+
 
+def _normaliza_serie_filtro(serie):
+    """Alinha com a chave: série na app costuma vir sem zeros à esquerda (ex. 1 em vez de 001)."""
+    if serie is None or (isinstance(serie, float) and pd.isna(serie)):
+        return ""
+    if isinstance(serie, (int, float)) and not isinstance(serie, bool):
+        try:
+            f = float(serie)
+            if f.is_integer():
+                return str(int(f))
+        except (ValueError, OverflowError):
+            pass
+    t = str(serie).strip()
+    if not t:
+        return ""
     try:
-        from st_aggrid import AgGrid, GridOptionsBuilder, DataReturnMode
-    except ImportError:
-        st.error(
-            "Instale **streamlit-aggrid** no mesmo Python do Streamlit: "
-            "`pip install streamlit-aggrid`"
-        )
-        st.dataframe(
-            _df_relatorio_leitura_abas_para_exibicao_sem_sep_milhar(df_raw),
-            hide_index=True,
-            height=height,
-        )
-        return df_raw
+        f = float(t.replace(",", "."))
+        if f.is_integer():
+            return str(int(f))
+    except ValueError:
+        pass
+    return t
 
-    df_base = df_raw.reset_index(drop=True).copy()
-    df_show = _df_relatorio_leitura_abas_para_exibicao_sem_sep_milhar(df_base.copy())
-    # Só AgGrid aqui: uma tabela nativa extra duplicava a mesma vista (confuso nas abas do relatório).
-    df_grid = df_show.copy()
-    df_grid.insert(0, "__garim_idx", range(len(df_grid)))
 
-    gb = GridOptionsBuilder.from_dataframe(
-        df_grid,
-        editable=False,
-        filter=True,
-        sortable=True,
-        resizable=True,
-    )
-    gb.configure_column(
-        "__garim_idx",
-        header_name="",
-        hide=True,
-        filter=False,
-        sortable=False,
-        resizable=False,
+def _modelo_serie_coincidem(row, modelo, serie):
+    m = row.get("Modelo")
+    s = row.get("Série")
+    if m is None or s is None:
+        return False
+    mn = _normaliza_modelo_filtro(modelo)
+    sn = _normaliza_serie_filtro(serie)
+    return (
+        str(m).strip() == mn
+        and _normaliza_serie_filtro(s) == sn
     )
-    gb.configure_grid_options(rowHeight=28, headerHeight=36)
-    grid_options = gb.build()
-    # from_dataframe força fitGridWidth e esmaga colunas; removemos para permitir scroll horizontal.
-    grid_options.pop("autoSizeStrategy", None)
-    _dc = dict(grid_options.get("defaultColDef") or {})
-    _dc.setdefault("minWidth", 140)
-    grid_options["defaultColDef"] = _dc
-    grid_options["suppressHorizontalScroll"] = False
-    _loc = _aggrid_locale_pt_br()
-    if _loc:
-        grid_options["localeText"] = _loc
 
-    resp = AgGrid(
-        df_grid,
-        gridOptions=grid_options,
-        height=height,
-        data_return_mode=DataReturnMode.FILTERED_AND_SORTED,
-        theme="streamlit",
-        key=grid_key,
-        show_download_button=False,
-        show_search=False,
-        enable_enterprise_modules=False,
-        update_on=["filterChanged", "sortChanged"],
-    )
 
-    df_vis = resp.data
-    if df_vis is None:
-        return df_base
-    if df_vis.empty:
-        return df_base.iloc[0:0].copy()
-    if "__garim_idx" not in df_vis.columns:
-        return df_base
+# --- VISTA NORMALIZADA DO RELATÓRIO GERAL ---
+# Colunas já normalizadas (mesmas regras das funções por linha: `_modelo_serie_coincidem`, `_nota_int_linha`,
+# `_linha_no_periodo`, `_chave44_de_linha`, `_chave_para_conjunto_export`), alinhadas por posição com o
+# DataFrame de origem. Calcula-se uma vez por DataFrame (o `df_geral` muda a cada reconstrução) e os seletores
+# de chaves passam a máscaras booleanas / `isin` em vez de `iterrows`.
+SESSION_KEY_DF_MEMO_POR_FRAME = "_df_memo_por_frame"
+_DF_MEMO_POR_FRAME_MAX = 64
+
+
+def _df_memo_por_frame(df: pd.DataFrame, nome: str, calcular):
+    """
+    `calcular(df)` memorizado na sessão por (DataFrame, nome). Referência fraca: a entrada cai quando o
+    DataFrame deixa de existir (ex.: novo `df_geral` após reconstrução), sem o manter vivo.
+    """
     try:
-        idx = (
-            pd.to_numeric(df_vis["__garim_idx"], errors="coerce")
-            .dropna()
-            .astype(int)
-            .tolist()
-        )
-    except (TypeError, ValueError, KeyError):
-        return df_base
-    if not idx:
-        return df_base.iloc[0:0].copy()
-    _n = len(df_base)
-    idx_ok = []
-    _seen = set()
-    for _i in idx:
-        try:
-            _j = int(_i)
-        except (TypeError, ValueError):
-            continue
-        if 0 <= _j < _n and _j not in _seen:
-            _seen.add(_j)
-            idx_ok.append(_j)
-    if not idx_ok:
-        return df_base.iloc[0:0].copy()
-    return df_base.iloc[idx_ok].reset_index(drop=True)
+        memo = st.session_state.get(SESSION_KEY_DF_MEMO_POR_FRAME)
+    except Exception:
+        memo = None
+    if not isinstance(memo, dict):
+        memo = {}
+    assinatura = (len(df), tuple(df.columns))
+    ent = memo.get((id(df), nome))
+    if ent is not None and ent[0]() is df and ent[1] == assinatura:
+        return ent[2]
+    v = calcular(df)
+    # Só DataFrames ainda vivos; poucos de cada vez (relatório geral e tabelas de detalhe, referência do pacote).
+    memo = {i: e for i, e in memo.items() if e[0]() is not None}
+    while len(memo) >= _DF_MEMO_POR_FRAME_MAX:
+        memo.pop(next(iter(memo)))
+    memo[(id(df), nome)] = (weakref.ref(df), assinatura, v)
+    try:
+        st.session_state[SESSION_KEY_DF_MEMO_POR_FRAME] = memo
+    except Exception:
+        pass
+    return v
 
 
-def _painel_zip_xml_filtrado(prefix, df_filtrado, cnpj_limpo, df_geral_full):
-    """ZIP com XMLs das chaves visíveis após filtros; também prepara descarga «aberta» (XML soltos)."""
-    cur_sig = _df_sig_hash_memo(df_filtrado)
-    kzip = f"{prefix}_zip_parts_ready"
-    kflat = f"{prefix}_xml_flat_ready"
-    ksig = f"{prefix}_zip_src_sig"
-    if st.session_state.get(ksig) != cur_sig:
-        st.session_state.pop(kzip, None)
-        st.session_state.pop(kflat, None)
-    st.session_state[ksig] = cur_sig
-    chaves = _chaves_lista_do_df(df_filtrado)
-    if not chaves:
-        return
-    if st.button(
-        "Gerar ZIP e XML soltos (linhas filtradas)",
-        key=f"{prefix}_btn_zip",
+def _serie_por_valores_unicos(s: pd.Series, fn) -> np.ndarray:
+    """`fn` aplicada uma vez por valor distinto de `s` (NaN incluído); devolve o array object por linha."""
+    codigos, unicos = pd.factorize(s, use_na_sentinel=True)
+    vals = np.empty(len(unicos) + 1, dtype=object)
+    for i, u in enumerate(unicos):
+        vals[i] = fn(u)
+    vals[-1] = fn(np.nan)
+    return vals[codigos]
+
+
+def _vista_chaves_calcular(df: pd.DataFrame) -> dict:
+    n = len(df)
+    cols = df.columns
+    vazio = np.full(n, None, dtype=object)
+    v = {}
+
+    if "Chave" in cols:
+        s = df["Chave"]
+        t = s.astype(str).str.strip()
+        rapido = (t.str.len() == 44) & t.str.isdigit().fillna(False) & s.notna()
+        c44 = np.where(rapido.to_numpy(), t.to_numpy(dtype=object), None)
+        cexp = c44.copy()
+        resto = np.flatnonzero(~rapido.to_numpy())
+        if len(resto):
+            brutos = s.to_numpy(dtype=object)[resto]
+            c44[resto] = [_chave44_de_linha({"Chave": x}) for x in brutos]
+            cexp[resto] = [_chave_para_conjunto_export(x) for x in brutos]
+        v["chave44"], v["chave"] = c44, cexp
+    else:
+        v["chave44"], v["chave"] = vazio, vazio
+
+    # `_modelo_serie_coincidem` recusa Modelo/Série `None` (mas não NaN, que vira "nan").
+    ms_ok = np.ones(n, dtype=bool)
+    for col, dest, fn in (
+        ("Modelo", "modelo", lambda x: str(x).strip()),
+        ("Série", "serie", _normaliza_serie_filtro),
     ):
-        with st.spinner("A ler o lote e a montar ZIP + lista de XML…"):
-            parts, tot, xml_flat = escrever_zip_dominio_por_chaves(
-                cnpj_limpo, chaves, df_geral_full
-            )
-        st.session_state[kzip] = parts
-        st.session_state[kflat] = xml_flat
-        if tot == 0:
-            st.warning(
-                "Nenhum XML do lote correspondeu a estas chaves (lote vazio ou chaves externas ao lote)."
-            )
-        else:
-            st.success(
-                f"Incluídos **{tot}** XML(s) em **{len(parts)}** parte(s) ZIP + **{len(xml_flat)}** para descarga aberta."
-            )
-    for idx, part in enumerate(st.session_state.get(kzip) or []):
-        if os.path.isfile(part):
-            with open(part, "rb") as fp:
-                st.download_button(
-                    rotulo_download_zip_parte(part),
-                    fp.read(),
-                    file_name=os.path.basename(part),
-                    key=f"{prefix}_dlz_{idx}_{hashlib.md5(part.encode()).hexdigest()[:8]}",
-                )
-    _flat = st.session_state.get(kflat) or []
-    if _flat:
-        st.caption(
-            "**XML soltos (aberto)** — um botão por ficheiro; o **ZIP** acima traz o mesmo conjunto com Excel em RELATORIO_GARIMPEIRO/."
-        )
-        chaves_ord = []
-        _seen_ch = set()
-        for _arc, _data, ch44, _td in _flat:
-            if ch44 and ch44 not in _seen_ch:
-                _seen_ch.add(ch44)
-                chaves_ord.append(ch44)
-        xb_ls = _excel_bytes_lista_especifica(df_geral_full, chaves_ord)
-        if xb_ls:
-            st.download_button(
-                "Baixar Excel da lista (mesmas chaves)",
-                data=xb_ls,
-                file_name=f"lista_especifica_{prefix}.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                key=f"{prefix}_dl_xlsx_lista_aberto",
-            )
-        nshow = min(MAX_XML_DOWNLOAD_ABERTO_UI, len(_flat))
-        for ji in range(nshow):
-            arc, data, _ch44, _tdk = _flat[ji]
-            st.download_button(
-                f"\u2b07\ufe0f {arc}",
-                data=data,
-                file_name=os.path.basename(arc),
-                mime="application/xml",
-                key=f"{prefix}_dlxml_{ji}_{hashlib.md5(str(arc).encode()).hexdigest()[:12]}",
-            )
-        if len(_flat) > MAX_XML_DOWNLOAD_ABERTO_UI:
-            st.caption(
-                f"Mostrando os primeiros **{MAX_XML_DOWNLOAD_ABERTO_UI}** de **{len(_flat)}** XML — use o **ZIP** para o pacote completo."
-            )
+        if col not in cols:
+            v[dest] = vazio
+            ms_ok[:] = False
+            continue
+        v[dest] = _serie_por_valores_unicos(df[col], fn)
+        if df[col].dtype == object:
+            ms_ok &= df[col].to_numpy(dtype=object) != None  # noqa: E711
+    v["ms_ok"] = ms_ok
+    v["modelo_norm"] = (
+        _serie_por_valores_unicos(df["Modelo"], _normaliza_modelo_filtro) if "Modelo" in cols else vazio
+    )
+
+    if "Nota" in cols and pd.api.types.is_numeric_dtype(df["Nota"]):
+        v["nota"] = np.trunc(df["Nota"].to_numpy(dtype="float64", na_value=np.nan))
+    elif "Nota" in cols:
+        v["nota"] = _serie_por_valores_unicos(df["Nota"], _nota_int_valor).astype("float64")
+    else:
+        v["nota"] = np.full(n, np.nan)
+
+    data = np.full(n, np.datetime64("NaT"), dtype="datetime64[ns]")
+    if "Data Emissão" in cols:
+        d10 = df["Data Emissão"].astype(str).str.strip().str[:10]
+        ok = (d10.str.len() >= 10) & (d10.str[4] == "-") & (d10.str[7] == "-") & df["Data Emissão"].notna()
+        data = pd.to_datetime(d10.where(ok), format="%Y-%m-%d", errors="coerce").to_numpy(dtype="datetime64[ns]")
+    v["data"] = data
+    # Sem data de emissão: mês (Ano, Mes) inteiro, como em `_linha_no_periodo`.
+    mes_ini = np.full(n, np.datetime64("NaT"), dtype="datetime64[ns]")
+    mes_fim = mes_ini.copy()
+    sem_data = np.flatnonzero(np.isnat(data))
+    if len(sem_data):
+        anos = df["Ano"].to_numpy(dtype=object)[sem_data] if "Ano" in cols else [None] * len(sem_data)
+        meses = df["Mes"].to_numpy(dtype=object)[sem_data] if "Mes" in cols else [None] * len(sem_data)
+        memo = {}
+        for pos, am in zip(sem_data, zip(anos, meses)):
+            try:
+                lo, hi = memo[am]
+            except KeyError:
+                lo, hi = memo.setdefault(am, _intervalo_mes_relatorio(*am))
+            except TypeError:  # par não «hashable»
+                lo, hi = _intervalo_mes_relatorio(*am)
+            if lo is not None:
+                mes_ini[pos], mes_fim[pos] = np.datetime64(lo, "ns"), np.datetime64(hi, "ns")
+    v["mes_ini"], v["mes_fim"] = mes_ini, mes_fim
+    return v
 
 
-def _excel_bytes_lista_especifica(df_geral, chaves_ordem_unicas):
+def _df_vista_chaves(df: pd.DataFrame) -> dict:
     """
-    Excel com número, série, chave, status, etc., alinhado ao relatório geral.
-    chaves_ordem_unicas: ordem estável das chaves 44 dígitos neste lote ZIP.
+    Vista normalizada de `df` — dict de arrays por linha: chave44, chave (`_chave_para_conjunto_export`),
+    modelo (texto da coluna), modelo_norm (`_normaliza_modelo_filtro`), serie (`_normaliza_serie_filtro`),
+    ms_ok (Modelo e Série não `None`), nota (float, NaN sem número), data (datetime64, NaT sem data ISO),
+    mes_ini / mes_fim (mês Ano/Mes quando não há data). Memorizada por DataFrame (`_df_memo_por_frame`).
     """
-    if not chaves_ordem_unicas:
-        return None
-    cols_pref = [
-        "Modelo",
-        "Série",
-        "Nota",
-        "Chave",
-        "Status Final",
-        "Origem",
-        "Operação",
-        "Data Emissão",
-        "CNPJ Emitente",
-        "Nome Emitente",
-        "Valor",
-        "Ano",
-        "Mes",
-    ]
-    por_chave = {}
-    if df_geral is not None and not df_geral.empty and "Chave" in df_geral.columns:
-        dfc = df_geral.copy()
-        dfc["_k44"] = dfc["Chave"].map(_chave44_digitos)
-        dfc = dfc[dfc["_k44"].notna()]
-        dfc = dfc.drop_duplicates(subset=["_k44"], keep="first")
-        for _, row in dfc.iterrows():
-            k44 = row["_k44"]
-            por_chave[k44] = row.drop(labels=["_k44"], errors="ignore")
+    return _df_memo_por_frame(df, "vista_chaves", _vista_chaves_calcular)
 
-    rows = []
-    vistos = set()
-    for ch in chaves_ordem_unicas:
-        if not ch or ch in vistos:
-            continue
-        vistos.add(ch)
-        if ch in por_chave:
-            rows.append(por_chave[ch].to_dict())
-        else:
-            rows.append({"Chave": ch})
 
-    out = pd.DataFrame(rows)
-    cols = [c for c in cols_pref if c in out.columns] + [
-        c for c in out.columns if c not in cols_pref
-    ]
-    out = out[[c for c in cols if c in out.columns]]
-    out = _df_com_data_emissao_dd_mm_yyyy(out)
-    buf = io.BytesIO()
-    with pd.ExcelWriter(buf, engine="xlsxwriter") as writer:
-        out.to_excel(writer, sheet_name="Lista", index=False)
-    return buf.getvalue()
+def _chaves_unicas_da_mascara(chaves: np.ndarray, mask) -> list:
+    """Chaves não vazias das linhas em `mask`, sem repetidas, pela ordem do DataFrame."""
+    return list(dict.fromkeys(c for c in chaves[np.asarray(mask, dtype=bool)] if c))
 
 
-def _zip_anexar_excel_lista_especifica(zf, df_geral, chaves_ordem, idx_parte):
-    if not chaves_ordem:
-        return
-    xb = _excel_bytes_lista_especifica(df_geral, chaves_ordem)
-    if xb:
-        zf.writestr(
-            f"RELATORIO_GARIMPEIRO/lista_especifica_pt{idx_parte:03d}.xlsx",
-            xb,
-        )
+def _mask_modelo_serie(v: dict, modelo, serie) -> np.ndarray:
+    """Equivalente vetorial de `_modelo_serie_coincidem` sobre a vista."""
+    mn = _normaliza_modelo_filtro(modelo)
+    sn = _normaliza_serie_filtro(serie)
+    return v["ms_ok"] & (v["modelo"] == mn) & (v["serie"] == sn)
 
 
-def _coletar_xmls_flat_dominio_por_chaves(cnpj_limpo, chaves_lista):
-    """
-    Lê o lote e devolve lista de (nome_na_raiz_do_zip, bytes, chave44, td_dedupe).
-    Mesma deduplicação que o ZIP de domínio (lista específica).
-    """
-    if not chaves_lista or not _garimpo_existem_fontes_xml_lote():
-        return []
-    ch_set = set()
-    for c in chaves_lista:
-        k = _chave44_digitos(c)
-        if k:
-            ch_set.add(k)
-    if not ch_set:
+def chaves_por_periodo_data(df_geral, d_ini, d_fim):
+    if df_geral is None or df_geral.empty:
         return []
-    usados = set()
-    ch44_ja_gravado = set()
-    out = []
-    for fn in _lista_nomes_fontes_xml_garimpo():
-        with _abrir_fonte_xml_garimpo_stream(fn) as ft:
-            for name, data in extrair_recursivo(ft, fn):
-                res, _ = identify_xml_info(data, cnpj_limpo, name)
-                ch44 = _chave44_digitos(res.get("Chave")) if res else None
-                if res and ch44 and ch44 in ch_set:
-                    td = _tupla_dedupe_export_xml(res, ch44)
-                    if td is None or td in ch44_ja_gravado:
-                        del data
-                        continue
-                    ch44_ja_gravado.add(td)
-                    arc = _nome_xml_raiz_zip_unico(usados, name)
-                    out.append((arc, data, ch44, td))
-                else:
-                    del data
-    return out
-
+    v = _df_vista_chaves(df_geral)
+    t0, t1 = np.datetime64(d_ini, "ns"), np.datetime64(d_fim, "ns")
+    data = v["data"]
+    com_data = ~np.isnat(data)
+    mask = np.where(
+        com_data,
+        (data >= t0) & (data <= t1),
+        ~np.isnat(v["mes_ini"]) & ~((v["mes_fim"] < t0) | (v["mes_ini"] > t1)),
+    )
+    return _chaves_unicas_da_mascara(v["chave44"], mask)
 
-def escrever_zip_dominio_por_chaves(cnpj_limpo, chaves_lista, df_geral=None):
-    """Gera um ou mais ZIPs (máx. MAX_XML_PER_ZIP XMLs cada); XMLs na raiz; Excel do lote em RELATORIO_GARIMPEIRO/.
-    Devolve (lista_caminhos absolutos, total_xml, lista_flat) — lista_flat = [(arc, bytes, ch44, td), …] para descargas abertas."""
-    flat = _coletar_xmls_flat_dominio_por_chaves(cnpj_limpo, chaves_lista)
-    if not flat:
-        return [], 0, []
-    zip_dir = Path(TEMP_UPLOADS_DIR) / "export_zip_lista_especifica"
-    try:
-        zip_dir.mkdir(parents=True, exist_ok=True)
-    except OSError:
-        pass
-    run_stamp = f"{int(time.time() * 1000)}_{random.randint(1, 999999999)}"
-    parts = []
-    part_idx = 1
-    count_xml = len(flat)
-    i = 0
-    while i < len(flat):
-        chunk = flat[i : i + MAX_XML_PER_ZIP]
-        i += len(chunk)
-        nome = zip_dir / f"faltantes_dominio_final_pt{part_idx}_{run_stamp}.zip"
-        try:
-            abs_path = nome.resolve()
-        except OSError:
-            abs_path = nome
-        zf = _zipfile_open_write_export(str(abs_path))
-        parts.append(str(abs_path))
-        chaves_excel_ordem = []
-        vistos_chave_excel = set()
-        try:
-            for arc, data, ch44, _td in chunk:
-                zf.writestr(arc, data)
-                if ch44 and ch44 not in vistos_chave_excel:
-                    vistos_chave_excel.add(ch44)
-                    chaves_excel_ordem.append(ch44)
-            _zip_anexar_excel_lista_especifica(
-                zf, df_geral, chaves_excel_ordem, part_idx
-            )
-        finally:
-            try:
-                zf.close()
-            except Exception:
-                pass
-        part_idx += 1
 
-    return parts, count_xml, flat
+def chaves_por_faixa_numeracao(df_geral, modelo, serie, n_ini, n_fim):
+    if df_geral is None or df_geral.empty:
+        return []
+    v = _df_vista_chaves(df_geral)
+    nota = v["nota"]
+    mask = _mask_modelo_serie(v, modelo, serie) & (nota >= n_ini) & (nota <= n_fim)
+    return _chaves_unicas_da_mascara(v["chave44"], mask)
 
 
-def _sped_c100_chave_nos_campos(parts: list, cod_mod: str) -> str:
-    """CHV_NFE (C100) ou CHV_CTE (D100): 44 dígitos nos campos típicos ou na linha."""
-    for idx in (9, 10, 11, 8):
-        if len(parts) <= idx:
-            continue
-        s = parts[idx].strip()
-        if len(s) == 44 and s.isdigit():
-            if not cod_mod or s[20:22] == cod_mod:
-                return s
-    linha = "|".join(parts)
-    cands = re.findall(r"\d{44}", linha)
-    if not cands:
-        return ""
-    if cod_mod and len(cod_mod) == 2:
-        for c in cands:
-            if c[20:22] == cod_mod:
-                return c
-    return cands[0]
+def chaves_por_nota_serie(df_geral, modelo, serie, nota):
+    if df_geral is None or df_geral.empty:
+        return []
+    v = _df_vista_chaves(df_geral)
+    mask = _mask_modelo_serie(v, modelo, serie) & (v["nota"] == nota)
+    return _chaves_unicas_da_mascara(v["chave44"], mask)
 
 
-def _sped_iter_registros_c100(texto: str) -> list:
-    out = []
-    for n_lin, line in enumerate(texto.splitlines(), 1):
-        if "C100" not in line:
-            continue
-        parts = line.split("|")
-        if len(parts) < 9:
-            continue
-        reg = (parts[1] or "").strip().upper()
-        if reg != "C100":
-            continue
-        cod_mod = (parts[5] if len(parts) > 5 else "").strip()
-        if not cod_mod:
-            continue
-        ser = (parts[7] if len(parts) > 7 else "").strip()
-        num_doc = (parts[8] if len(parts) > 8 else "").strip()
-        ind_oper = (parts[2] if len(parts) > 2 else "").strip()
-        ind_emit = (parts[3] if len(parts) > 3 else "").strip()
-        chave = _sped_c100_chave_nos_campos(parts, cod_mod)
-        out.append(
-            {
-                "Linha": n_lin,
-                "REG_SPED": "C100",
-                "COD_MOD": cod_mod,
-                "SER": ser,
-                "NUM_DOC": num_doc,
-                "CHV_NFE": chave,
-                "IND_OPER": ind_oper,
-                "IND_EMIT": ind_emit,
-            }
-        )
-    return out
+# Texto espelhado na área «copiar guia» (alinhar ao fluxo real da app)
+_TEXTO_GUIA_GARIMPEIRO_PC = """
+Garimpeiro — Manual em texto simples (para copiar)
 
+=== O QUE É LIDO E O QUE RECEBE ===
+Dados extraídos dos XML (e cruzamentos opcionais):
+• Identificação do documento: chave de 44 dígitos, modelo/tipo, série, número, datas de emissão, valores, operação, UF, emitente e destinatário quando constam no ficheiro.
+• Classificação por linha: emissão própria (seu CNPJ como emitente) vs. terceiros (documentos recebidos).
+• Agregados: resumo por série (totais), lista geral, canceladas, inutilizadas, autorizadas, buracos na numeração (com ou sem referência «último nº + mês» na lateral).
+• Um mesmo número de nota pode ter vários ficheiros XML (ex.: NF-e + evento) — várias linhas com a mesma chave ou lógica equivalente.
 
-def _sped_iter_registros_d100(texto: str) -> list:
-    out = []
-    for n_lin, line in enumerate(texto.splitlines(), 1):
-        if "D100" not in line:
-            continue
-        parts = line.split("|")
-        if len(parts) < 10:
-            continue
-        reg = (parts[1] or "").strip().upper()
-        if reg != "D100":
-            continue
-        cod_mod = (parts[5] if len(parts) > 5 else "").strip()
-        if not cod_mod:
-            continue
-        ser = (parts[7] if len(parts) > 7 else "").strip()
-        num_doc = (parts[9] if len(parts) > 9 else "").strip()
-        ind_oper = (parts[2] if len(parts) > 2 else "").strip()
-        ind_emit = (parts[3] if len(parts) > 3 else "").strip()
-        chave = _sped_c100_chave_nos_campos(parts, cod_mod)
-        out.append(
-            {
-                "Linha": n_lin,
-                "REG_SPED": "D100",
-                "COD_MOD": cod_mod,
-                "SER": ser,
-                "NUM_DOC": num_doc,
-                "CHV_NFE": chave,
-                "IND_OPER": ind_oper,
-                "IND_EMIT": ind_emit,
-            }
-        )
-    return out
+Ficheiros e descargas que pode obter:
+• Nesta página: tabelas e indicadores (KPI) sobre o lote atual.
+• Excel: relatório geral completo; em Etapa 3 — «só Excel» (lote inteiro ou só linhas filtradas); em «lista específica» — planilhas por chaves, faixa, período, etc. (ver botões dessa zona).
+• ZIP (Etapa 3): até 10 000 XML por parte; modos «tudo» (filtros não cortam XML) ou «filtrado» (só XML das linhas filtradas); estrutura em raiz ou por pastas. Em cada parte: pasta RELATORIO_GARIMPEIRO/ com Excel desse envio.
+• PDF: resumo visual do painel (se a biblioteca fpdf2 estiver disponível — mensagem na app se faltar).
+• Modelo Excel para inutilizadas declaradas manualmente (quando usar essa funcionalidade).
 
+=== GARIMPEIRO RAIZ (linha de comandos) vs. ESTA PÁGINA ===
+• **SPED EFD (.txt):** pode anexar no **opcional do primeiro passo** (com as planilhas) ou no **fim do painel direito** — **gravar XML na pasta**, **ZIP** (cruzamento SPED×lote) e **Excel** de pendências (só no SPED). O pacote «Apuração final» em ZIP (Garimpeiro Raiz CLI) é outro fluxo.
 
-def _sped_dedupe_regs(regs: list) -> list:
-    visto = set()
-    unicos = []
-    for r in regs:
-        ch = (r.get("CHV_NFE") or "").strip()
-        if len(ch) == 44 and ch.isdigit():
-            k = ("K", ch)
-        else:
-            k = ("M", r.get("COD_MOD", ""), r.get("SER", ""), r.get("NUM_DOC", ""))
-        if k in visto:
-            continue
-        visto.add(k)
-        unicos.append(r)
-    return unicos
+=== MANUAL PASSO A PASSO ===
+1. Lateral: CNPJ do emitente (cliente) — só os 14 dígitos ou cole já mascarado; clique em Liberar operação.
+2. Envie ZIP ou XML soltos (grandes volumes são suportados).
+3. Iniciar grande garimpo e aguardar o processamento.
+4. Depois do primeiro resultado, pode acrescentar mais XML/ZIP no topo da página sem reiniciar o garimpo.
+5. (Opcional) Lateral «Último nº por série»: afeta só o cálculo de buracos — **só as séries que preencher e guardar**; âncora por último nº e mês. O garimpo e o resumo por série continuam totais. Sem Guardar referência válida, buracos usam todo o intervalo lido em emissão própria.
+6. Inutilizadas: a partir dos buracos, por planilha (Excel/CSV) ou faixa — só números que já forem buraco listado (não alarga intervalos).
+7. Painel à direita: **Processar Dados** grava XML/ZIP extra, aplica inutilizações «sem XML» (se configurou) e recalcula a partir da pasta de uploads.
+8. Etapa 3: filtros em cascata (emissão própria e terceiros em colunas separadas). Na caixa **Tipo de exportação** escolha ZIP (tudo ou filtrado, raiz ou pastas) ou Excel (lote completo ou só filtrado). Depois use **Gerar — sua empresa**, **Gerar — terceiros** ou **Gerar os dois lados**. **SPED:** anexe o `.txt` no **opcional** do 1.º passo ou no **fim do painel direito** — XML na pasta, **ZIP** e **Excel** de pendências. O menu completo da CLI Raiz tem outras opções.
+9. Lista específica (secção própria): exporte subconjuntos por chaves, faixa, período, série ou uma nota — em Excel e/ou ZIP conforme os botões apresentados.
 
+=== DICAS ===
+• Resetar sistema: limpa sessão e temporários ao mudar de cliente ou recomeçar.
+• Nos filtros, lista vazia = esse critério não restringe. Opções inválidas após mudar outro filtro são limpas automaticamente.
+• Nomes de modelos na app: NF-e, NFS-e, NFC-e, CT-e, CT-e OS (mod. 67), MDF-e, Outros (cartas de correção não são lidas).
+""".strip()
 
-def _sped_texto_unir_c100_d100(texto: str) -> list:
-    return _sped_dedupe_regs(_sped_iter_registros_c100(texto) + _sped_iter_registros_d100(texto))
+_TEXTO_GUIA_GARIMPEIRO_WEB = """
+Garimpeiro — Manual em texto simples (para copiar)
 
+=== O QUE É LIDO E O QUE RECEBE ===
+Dados extraídos dos XML (e cruzamentos opcionais):
+• Identificação do documento: chave de 44 dígitos, modelo/tipo, série, número, datas de emissão, valores, operação, UF, emitente e destinatário quando constam no ficheiro.
+• Classificação por linha: emissão própria (seu CNPJ como emitente) vs. terceiros (documentos recebidos).
+• Agregados: resumo por série (totais), lista geral, canceladas, inutilizadas, autorizadas, buracos na numeração (com ou sem referência «último nº + mês» na lateral).
+• Um mesmo número de nota pode ter vários ficheiros XML (ex.: NF-e + evento) — várias linhas com a mesma chave ou lógica equivalente.
 
-def _sped_chaves44_de_texto(texto: str) -> list:
-    """Chaves de 44 dígitos extraídas dos registos C100/D100 com CHV preenchida."""
-    regs = _sped_texto_unir_c100_d100(texto)
-    seen = []
-    ok = set()
-    for r in regs:
-        ch = (r.get("CHV_NFE") or "").strip()
-        if len(ch) == 44 and ch.isdigit():
-            if ch not in ok:
-                ok.add(ch)
-                seen.append(ch)
-    return seen
+Ficheiros e descargas que pode obter:
+• Nesta página: tabelas e indicadores (KPI) sobre o lote atual.
+• Excel: relatório geral completo; em Etapa 3 — «só Excel» (lote inteiro ou só linhas filtradas); em «lista específica» — planilhas por chaves, faixa, período, etc. (ver botões dessa zona).
+• ZIP (Etapa 3): até 10 000 XML por parte; modos «tudo» (filtros não cortam XML) ou «filtrado» (só XML das linhas filtradas); estrutura em raiz ou por pastas. Em cada parte: pasta RELATORIO_GARIMPEIRO/ com Excel desse envio.
+• PDF: resumo visual do painel (se a biblioteca fpdf2 estiver disponível — mensagem na app se faltar).
+• Modelo Excel para inutilizadas declaradas manualmente (quando usar essa funcionalidade).
 
+=== MANUAL PASSO A PASSO ===
+1. Lateral: CNPJ do emitente (cliente) — só os 14 dígitos ou cole já mascarado; clique em Liberar operação.
+2. Envie ZIP ou XML soltos (grandes volumes são suportados).
+3. Iniciar grande garimpo e aguardar o processamento.
+4. Depois do primeiro resultado, pode acrescentar mais XML/ZIP no topo da página sem reiniciar o garimpo.
+5. (Opcional) Lateral «Último nº por série»: afeta só o cálculo de buracos — **só as séries que preencher e guardar**; âncora por último nº e mês. O garimpo e o resumo por série continuam totais. Sem Guardar referência válida, buracos usam todo o intervalo lido em emissão própria.
+6. Inutilizadas: a partir dos buracos, por planilha (Excel/CSV) ou faixa — só números que já forem buraco listado (não alarga intervalos).
+7. Painel à direita: **Processar Dados** aplica inutilizações «sem XML» (se configurou) e recalcula o relatório.
+8. Etapa 3: filtros em cascata (emissão própria e terceiros em colunas separadas). Na caixa **Tipo de exportação** escolha ZIP ou Excel. Depois use **Gerar — sua empresa**, **Gerar — terceiros** ou **Gerar os dois lados**. **SPED:** anexe o `.txt` no **opcional** do 1.º passo ou no **fim do painel direito** — use **Descarregar** para obter **ZIP** e **Excel** de pendências no browser.
+9. Lista específica (secção própria): exporte subconjuntos por chaves, faixa, período, série ou uma nota — em Excel e/ou ZIP conforme os botões apresentados.
 
-# Texto do ficheiro SPED (.txt) na sessão (anexo no 1.º passo ao iniciar garimpo, ou no painel direito).
-SPED_SESSION_TEXT_KEY = "sped_efd_texto_sessao"
-SPED_SESSION_NAME_KEY = "sped_efd_nome_ficheiro_sessao"
-# Relatório detalhado: chaves C100/D100 no SPED sem XML correspondente no lote lido.
-SPED_FALTANTES_XML_DF_KEY = "df_sped_faltantes_xml"
-SPED_FALTANTES_XLSX_PATH_KEY = "sped_faltantes_xlsx_caminho"
+=== DICAS ===
+• Resetar sistema: limpa sessão e temporários ao mudar de cliente ou recomeçar.
+• Nos filtros, lista vazia = esse critério não restringe. Opções inválidas após mudar outro filtro são limpas automaticamente.
+• Nomes de modelos na app: NF-e, NFS-e, NFC-e, CT-e, CT-e OS (mod. 67), MDF-e, Outros (cartas de correção não são lidas).
+""".strip()
 
 
-def _decode_sped_upload_bytes(raw_b: bytes) -> str:
-    if not raw_b:
-        return ""
-    for enc in ("utf-8-sig", "utf-8", "latin-1", "cp1252"):
-        try:
-            return raw_b.decode(enc)
-        except UnicodeDecodeError:
-            continue
-    return raw_b.decode("latin-1", errors="replace")
+def texto_guia_garimpeiro() -> str:
+    """Texto do manual copiável: variantes Cloud vs PC local (sem referências a pastas D:\\ na Cloud)."""
+    if _streamlit_likely_community_cloud():
+        return _TEXTO_GUIA_GARIMPEIRO_WEB
+    return _TEXTO_GUIA_GARIMPEIRO_PC
 
 
-def _sped_resolver_texto_de_uploader(upload_widget) -> str:
-    """Prioridade: ficheiro anexado no widget; senão texto já importado para a sessão (`SPED_SESSION_TEXT_KEY`)."""
-    if upload_widget is not None:
-        raw_b = upload_widget.read()
-        try:
-            upload_widget.seek(0)
-        except Exception:
-            pass
-        texto = _decode_sped_upload_bytes(raw_b)
-        st.session_state[SPED_SESSION_TEXT_KEY] = texto
-        st.session_state[SPED_SESSION_NAME_KEY] = getattr(upload_widget, "name", None) or "SPED.txt"
-        return texto.strip()
-    return str(st.session_state.get(SPED_SESSION_TEXT_KEY) or "").strip()
+# --- BENCHMARK (modo sem interface) ---
+# Gerador determinístico de lotes fiscais sintéticos (NF-e / NFC-e / CT-e / MDF-e, eventos 110111,
+# inutilizações, várias séries com buracos, ZIP «matriosca») e medição por etapa do pipeline.
+# Uso: GARIMPEIRO_HEADLESS=1 python app.py benchmark --tamanhos 10000,100000 --json bench.json
+# A etapa «identify_por_tipo» reparte o tempo do identify por NF-e / NFC-e / CT-e / MDF-e / inutilização /
+# evento; a paridade campo a campo com a versão anterior está em tests/test_identificacao_paridade.py.
+
+_BENCH_VERSAO_GERADOR = 1
+_BENCH_CNPJ_CLIENTE = "11222333000181"
+_BENCH_DOCS_POR_ZIP = 5000
+_BENCH_DOCS_POR_ZIP_INTERNO = 500
+_BENCH_TAMANHOS_PADRAO = (10_000, 100_000, 1_000_000)
+
+
+def _bench_dv_mod11(base: str, peso_max: int = 9) -> int:
+    """Dígito verificador módulo 11 (pesos 2..peso_max da direita para a esquerda)."""
+    soma = 0
+    peso = 2
+    for c in reversed(base):
+        soma += int(c) * peso
+        peso = 2 if peso >= peso_max else peso + 1
+    r = soma % 11
+    return 0 if r < 2 else 11 - r
+
+
+def _bench_cnpj_com_dv(base12: str) -> str:
+    """Completa um CNPJ de 12 dígitos com os dois verificadores."""
+    d1 = _bench_dv_mod11(base12)
+    d2 = _bench_dv_mod11(base12 + str(d1))
+    return f"{base12}{d1}{d2}"
+
+
+def _bench_chave44(cuf: int, aamm: str, cnpj: str, mod: int, serie: int, num: int, cod: int) -> str:
+    """Chave de acesso de 44 dígitos com DV módulo 11 (mesmo layout da SEFAZ)."""
+    base = f"{cuf:02d}{aamm}{cnpj}{mod:02d}{serie:03d}{num:09d}1{cod:08d}"
+    return base + str(_bench_dv_mod11(base))
+
+
+def _bench_xml_nfe(ch: str, emit: str, dest: str, tp_nf: str, valor: str, n_itens: int, cstat: str = "100") -> bytes:
+    """nfeProc (NF-e modelo 55 ou NFC-e 65, conforme a chave) com protocolo."""
+    mod = ch[20:22]
+    serie = int(ch[22:25])
+    num = int(ch[25:34])
+    dh = f"20{ch[2:4]}-{ch[4:6]}-{1 + num % 28:02d}T10:00:00-03:00"
+    det = "".join(
+        f'<det nItem="{i}"><prod><cProd>{i:05d}</cProd><xProd>PRODUTO SINTETICO {i}</xProd>'
+        f"<NCM>84713012</NCM><CFOP>5102</CFOP><qCom>1.0000</qCom><vProd>{valor}</vProd></prod></det>"
+        for i in range(1, n_itens + 1)
+    )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<nfeProc xmlns="http://www.portalfiscal.inf.br/nfe" versao="4.00">'
+        f'<NFe><infNFe Id="NFe{ch}" versao="4.00"><ide><cUF>{ch[:2]}</cUF><mod>{mod}</mod>'
+        f"<serie>{serie}</serie><nNF>{num}</nNF><dhEmi>{dh}</dhEmi><tpNF>{tp_nf}</tpNF></ide>"
+        f"<emit><CNPJ>{emit}</CNPJ><xNome>EMPRESA {emit[:8]} LTDA</xNome><enderEmit><UF>SP</UF></enderEmit></emit>"
+        f"<dest><CNPJ>{dest}</CNPJ><xNome>DESTINATARIO {dest[:8]}</xNome><enderDest><UF>MG</UF></enderDest></dest>"
+        f"{det}<total><ICMSTot><vNF>{valor}</vNF></ICMSTot></total></infNFe></NFe>"
+        f"<protNFe><infProt><chNFe>{ch}</chNFe><dhRecbto>{dh}</dhRecbto><cStat>{cstat}</cStat></infProt></protNFe></nfeProc>"
+    ).encode("utf-8")
+
+
+def _bench_xml_cte(ch: str, emit: str, tomador: str, valor: str) -> bytes:
+    """cteProc (CT-e modelo 57) com o cliente como remetente e destinatário."""
+    num = int(ch[25:34])
+    dh = f"20{ch[2:4]}-{ch[4:6]}-{1 + num % 28:02d}T08:00:00-03:00"
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?><cteProc xmlns="http://www.portalfiscal.inf.br/cte" versao="4.00">'
+        f'<CTe><infCte Id="CTe{ch}"><ide><mod>57</mod><serie>{int(ch[22:25])}</serie><nCT>{num}</nCT>'
+        f"<dhEmi>{dh}</dhEmi></ide><emit><CNPJ>{emit}</CNPJ><xNome>TRANSPORTADORA {emit[:8]}</xNome></emit>"
+        f"<rem><CNPJ>{tomador}</CNPJ></rem><dest><CNPJ>{tomador}</CNPJ><xNome>CLIENTE</xNome>"
+        f"<enderDest><UF>SP</UF></enderDest></dest><vPrest><vTPrest>{valor}</vTPrest></vPrest></infCte></CTe>"
+        f"<protCTe><infProt><chCTe>{ch}</chCTe><cStat>100</cStat></infProt></protCTe></cteProc>"
+    ).encode("utf-8")
 
 
-def _garimpo_tem_sped_no_inicio_grand_garimpo() -> bool:
-    """SPED no 1.º passo: texto já na sessão ou ficheiro anexado no widget antes de «Iniciar grande garimpo»."""
-    if str(st.session_state.get(SPED_SESSION_TEXT_KEY) or "").strip():
-        return True
-    w = st.session_state.get("sped_sessao_upload_ini")
-    if w is None:
-        return False
-    try:
-        raw = w.read()
-        try:
-            w.seek(0)
-        except Exception:
-            pass
-        return bool(_decode_sped_upload_bytes(raw).strip()) if raw else False
-    except Exception:
-        return False
+def _bench_xml_mdfe(ch: str, emit: str) -> bytes:
+    """mdfeProc (MDF-e modelo 58) emitido pelo cliente."""
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?><mdfeProc xmlns="http://www.portalfiscal.inf.br/mdfe" versao="3.00">'
+        f'<MDFe><infMDFe Id="MDFe{ch}"><ide><mod>58</mod><serie>{int(ch[22:25])}</serie>'
+        f"<nMDF>{int(ch[25:34])}</nMDF><dhEmi>20{ch[2:4]}-{ch[4:6]}-10T08:00:00-03:00</dhEmi></ide>"
+        f"<emit><CNPJ>{emit}</CNPJ><xNome>EMPRESA {emit[:8]} LTDA</xNome></emit></infMDFe></MDFe>"
+        f"<protMDFe><infProt><chMDFe>{ch}</chMDFe><cStat>100</cStat></infProt></protMDFe></mdfeProc>"
+    ).encode("utf-8")
 
 
-def _garimpo_escrita_espelho_final_continua_ativa() -> bool:
-    """
-    Há pasta de espelho **Garimpeiro_Local_*** definida (PC / servidor próprio).
-    Durante o ciclo de leitura **não** se grava o pacote em disco (só memória / temp).
-    A gravação do espelho corre **uma vez**, no **segundo** render do ecrã de resultados
-    (primeiro mostra só o relatório; depois `st.rerun` grava o ZIP na pasta).
-    Na Community Cloud fica desligado.
-    """
-    if _streamlit_likely_community_cloud():
-        return False
-    return bool(str(st.session_state.get("garimpo_lote_espelho_root") or "").strip())
+def _bench_xml_evento_cancelamento(ch: str) -> bytes:
+    """procEventoNFe de cancelamento (tpEvento 110111, cStat 135)."""
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?><procEventoNFe xmlns="http://www.portalfiscal.inf.br/nfe" versao="1.00">'
+        f"<evento><infEvento><cOrgao>{ch[:2]}</cOrgao><CNPJ>{ch[6:20]}</CNPJ><chNFe>{ch}</chNFe>"
+        f"<dhEvento>20{ch[2:4]}-{ch[4:6]}-28T10:00:00-03:00</dhEvento><tpEvento>110111</tpEvento>"
+        "<detEvento><descEvento>Cancelamento</descEvento><xJust>Erro na emissao da nota</xJust></detEvento>"
+        f"</infEvento></evento><retEvento><infEvento><cStat>135</cStat><chNFe>{ch}</chNFe>"
+        f"<dhRegEvento>20{ch[2:4]}-{ch[4:6]}-28T10:00:01-03:00</dhRegEvento></infEvento></retEvento></procEventoNFe>"
+    ).encode("utf-8")
 
 
-def _garimpo_hidratar_sped_sessao_do_widget_ini() -> None:
-    """Antes da leitura em ciclo: copia o SPED do widget do 1.º passo para a sessão."""
-    _sped_u_ini = st.session_state.get("sped_sessao_upload_ini")
-    if _sped_u_ini is None:
-        return
-    try:
-        _rsped_b = _sped_u_ini.read()
-        try:
-            _sped_u_ini.seek(0)
-        except Exception:
-            pass
-        st.session_state[SPED_SESSION_TEXT_KEY] = _decode_sped_upload_bytes(_rsped_b).strip()
-        st.session_state[SPED_SESSION_NAME_KEY] = getattr(
-            _sped_u_ini, "name", None
-        ) or "SPED.txt"
-    except Exception:
-        pass
+def _bench_xml_inutilizacao(cnpj: str, ano: str, mod: int, serie: int, ini: int, fin: int) -> bytes:
+    """procInutNFe homologado (cStat 102) para a faixa ini..fin."""
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?><procInutNFe xmlns="http://www.portalfiscal.inf.br/nfe" versao="4.00">'
+        f'<inutNFe><infInut Id="ID35{ano}{cnpj}{mod:02d}{serie:03d}{ini:09d}{fin:09d}"><tpAmb>1</tpAmb>'
+        f"<xServ>INUTILIZAR</xServ><cUF>35</cUF><ano>{ano}</ano><CNPJ>{cnpj}</CNPJ><mod>{mod}</mod>"
+        f"<serie>{serie}</serie><nNFIni>{ini}</nNFIni><nNFFin>{fin}</nNFFin><xJust>Falha no sistema emissor</xJust>"
+        f"</infInut></inutNFe><retInutNFe><infInut><cStat>102</cStat><dhRecbto>20{ano}-01-10T10:00:00-03:00</dhRecbto>"
+        "</infInut></retInutNFe></procInutNFe>"
+    ).encode("utf-8")
 
 
-def _dataframe_sped_chaves_sem_xml_no_lote(texto_sped: str, matched_ch: set) -> pd.DataFrame:
-    """Uma linha por chave de 44 dígitos presente no SPED (C100/D100) e não encontrada no lote (sem XML cruzado)."""
-    regs = _sped_texto_unir_c100_d100(texto_sped)
-    seen = set()
-    rows = []
-    for r in regs:
-        ch = (r.get("CHV_NFE") or "").strip()
-        if len(ch) != 44 or not ch.isdigit():
-            continue
-        if ch in matched_ch:
+def _bench_iter_documentos(n_docs: int, semente: int, cnpj_cliente: str = _BENCH_CNPJ_CLIENTE):
+    """
+    Gera (nome, bytes) de forma determinística para ``n_docs`` documentos fiscais, mais os eventos de
+    cancelamento (~1,5 % das próprias) e as inutilizações (metade dos buracos), que vêm logo a seguir à nota.
+    Mistura: NF-e própria saída (séries 1 e 2) e entrada, NFC-e (séries 1–3), MDF-e próprio, NF-e e CT-e
+    de terceiros; emissão espalhada por 3 meses; ~0,4 % de saltos de numeração (buracos de 1 a 3 notas).
+    """
+    rnd = random.Random(semente)
+    terceiros = [_bench_cnpj_com_dv(f"{rnd.randrange(10**7, 10**8)}0001") for _ in range(40)]
+    transportadoras = terceiros[:6]
+    # (modelo, série) → último número emitido; as séries de terceiros ficam por emitente.
+    prox = defaultdict(int)
+    # Pesos acumulados: (limite, tipo).
+    tabela = (
+        (0.55, "nfe_saida_s1"),
+        (0.62, "nfe_saida_s2"),
+        (0.66, "nfe_entrada"),
+        (0.80, "nfce"),
+        (0.82, "mdfe"),
+        (0.94, "nfe_terceiros"),
+        (1.00, "cte_terceiros"),
+    )
+    meses = ("2401", "2402", "2403")
+    for i in range(n_docs):
+        aamm = meses[min(len(meses) - 1, (i * len(meses)) // max(1, n_docs))]
+        r = rnd.random()
+        tipo = next(t for lim, t in tabela if r < lim)
+        valor = f"{rnd.randint(500, 5_000_000) / 100:.2f}"
+        cod = rnd.randrange(10**8)
+        if tipo in ("nfe_terceiros", "cte_terceiros"):
+            emit = rnd.choice(transportadoras if tipo == "cte_terceiros" else terceiros)
+            mod = 57 if tipo == "cte_terceiros" else 55
+            prox[(emit, mod)] += 1
+            ch = _bench_chave44(35, aamm, emit, mod, 1, prox[(emit, mod)], cod)
+            if mod == 57:
+                yield f"{ch}-procCTe.xml", _bench_xml_cte(ch, emit, cnpj_cliente, valor)
+            else:
+                yield f"{ch}-procNFe.xml", _bench_xml_nfe(ch, emit, cnpj_cliente, "1", valor, rnd.randint(1, 6))
             continue
-        if ch in seen:
+        if tipo == "mdfe":
+            mod, serie = 58, 1
+        elif tipo == "nfce":
+            mod, serie = 65, rnd.randint(1, 3)
+        elif tipo == "nfe_saida_s2":
+            mod, serie = 55, 2
+        else:
+            mod, serie = 55, 1
+        num = prox[(mod, serie)] + 1
+        if mod in (55, 65) and rnd.random() < 0.004:
+            salto = rnd.randint(1, 3)
+            if rnd.random() < 0.5:
+                yield (
+                    f"inut_{mod}_{serie}_{num}_{num + salto - 1}.xml",
+                    _bench_xml_inutilizacao(cnpj_cliente, "24", mod, serie, num, num + salto - 1),
+                )
+            num += salto
+        prox[(mod, serie)] = num
+        ch = _bench_chave44(35, aamm, cnpj_cliente, mod, serie, num, cod)
+        if mod == 58:
+            yield f"{ch}-procMDFe.xml", _bench_xml_mdfe(ch, cnpj_cliente)
             continue
-        seen.add(ch)
-        rows.append(
-            {
-                "Chave": ch,
-                "REG_SPED": r.get("REG_SPED", ""),
-                "COD_MOD": r.get("COD_MOD", ""),
-                "Serie": r.get("SER", ""),
-                "NUM_DOC": r.get("NUM_DOC", ""),
-                "Linha_SPED": r.get("Linha", ""),
-                "Motivo": "Consta no SPED (C100/D100); sem XML correspondente no lote atual",
-            }
-        )
-    if not rows:
-        return pd.DataFrame(
-            columns=[
-                "Chave",
-                "REG_SPED",
-                "COD_MOD",
-                "Serie",
-                "NUM_DOC",
-                "Linha_SPED",
-                "Motivo",
-            ]
-        )
-    return pd.DataFrame(rows)
+        tp = "0" if tipo == "nfe_entrada" else "1"
+        sufixo = "procNFCe" if mod == 65 else "procNFe"
+        yield f"{ch}-{sufixo}.xml", _bench_xml_nfe(ch, cnpj_cliente, rnd.choice(terceiros), tp, valor, rnd.randint(1, 12))
+        if rnd.random() < 0.015:
+            yield f"{ch}-procEventoNFe.xml", _bench_xml_evento_cancelamento(ch)
 
 
-def _extrair_pares_xml_intersecao_sped_lote(cnpj_limpo: str, texto_sped: str):
+def _bench_zip_bytes(membros) -> bytes:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
+        for nome, dados in membros:
+            zf.writestr(nome, dados)
+    return buf.getvalue()
+
+
+def _bench_gerar_lote(pasta, n_docs: int, semente: int = 42) -> dict:
     """
-    XML do lote cuja chave 44 está em C100/D100 do SPED.
-    Devolve (lista [(nome_arquivo, bytes)], matched_chaves_44, chaves_sped_44, erros_amostra).
+    Grava em ``pasta`` o lote sintético: ``lote_NNNN.zip`` com até _BENCH_DOCS_POR_ZIP documentos
+    (parte em pastas AAAA-MM/, parte em ZIP interno ``remessas/remessa_NN.zip``; cada 4.º ZIP interno
+    leva ainda ``sub/parte.zip`` — três níveis de «matriosca») e alguns XML soltos.
+    Reutiliza o lote se o manifesto (tamanho, semente, versão do gerador) coincidir.
+    Devolve o manifesto {"n_docs", "semente", "versao_gerador", "xml", "bytes", "ficheiros"}.
     """
-    chaves_ord = _sped_chaves44_de_texto(texto_sped)
-    ch_set = set(chaves_ord)
-    if not ch_set:
-        return [], set(), set(), []
-    cnpj = "".join(c for c in str(cnpj_limpo or "") if c.isdigit())[:14]
-    usados_nomes = set()
-    ch44_ja_gravado = set()
-    matched_ch = set()
-    pairs = []
-    erros = []
-    for fn in _lista_nomes_fontes_xml_garimpo():
-        with _abrir_fonte_xml_garimpo_stream(fn) as ft:
-            for name, data in extrair_recursivo(ft, fn):
-                try:
-                    res, _ = identify_xml_info(data, cnpj, name)
-                    ch44 = _chave44_digitos(res.get("Chave")) if res else None
-                    if res and ch44 and ch44 in ch_set:
-                        td = _tupla_dedupe_export_xml(res, ch44)
-                        if td is None or td in ch44_ja_gravado:
-                            continue
-                        ch44_ja_gravado.add(td)
-                        arc = _nome_xml_raiz_zip_unico(usados_nomes, name)
-                        raw = data if isinstance(data, (bytes, bytearray)) else bytes(data)
-                        pairs.append((arc, raw))
-                        matched_ch.add(ch44)
-                except OSError as e:
-                    erros.append(str(e))
-                finally:
-                    del data
-    return pairs, matched_ch, ch_set, erros
+    pasta = Path(pasta)
+    pasta.mkdir(parents=True, exist_ok=True)
+    man_path = pasta / "_bench_manifesto.json"
+    try:
+        man = json.loads(man_path.read_text(encoding="utf-8"))
+        if (
+            man.get("n_docs") == n_docs
+            and man.get("semente") == semente
+            and man.get("versao_gerador") == _BENCH_VERSAO_GERADOR
+            and all((pasta / f).is_file() for f in man.get("ficheiros") or ())
+        ):
+            man["reutilizado"] = True
+            return man
+    except (OSError, ValueError):
+        pass
+    for f in pasta.iterdir():
+        if f.is_file() and f.name != man_path.name:
+            f.unlink()
+
+    ficheiros = []
+    tot = {"xml": 0, "bytes": 0}
+    soltos = 20
+
+    def _fechar_zip(n_zip, bloco):
+        nome_zip = f"lote_{n_zip:04d}.zip"
+        with zipfile.ZipFile(pasta / nome_zip, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
+            corte = (len(bloco) * 3) // 5
+            for nome, dados in bloco[:corte]:
+                ch = nome[:44]
+                sub = f"20{ch[2:4]}-{ch[4:6]}" if ch.isdigit() else "eventos"
+                zf.writestr(f"{sub}/{nome}", dados)
+            resto = bloco[corte:]
+            for j in range(0, len(resto), _BENCH_DOCS_POR_ZIP_INTERNO):
+                parte = resto[j : j + _BENCH_DOCS_POR_ZIP_INTERNO]
+                n_int = j // _BENCH_DOCS_POR_ZIP_INTERNO
+                if n_int % 4 == 3 and len(parte) > 10:
+                    meio = len(parte) // 2
+                    parte = parte[:meio] + [("sub/parte.zip", _bench_zip_bytes(parte[meio:]))]
+                zf.writestr(f"remessas/remessa_{n_int:02d}.zip", _bench_zip_bytes(parte))
+        ficheiros.append(nome_zip)
+
+    bloco = []
+    n_zip = 0
+    for nome, dados in _bench_iter_documentos(n_docs, semente):
+        tot["xml"] += 1
+        tot["bytes"] += len(dados)
+        if soltos:
+            soltos -= 1
+            (pasta / nome).write_bytes(dados)
+            ficheiros.append(nome)
+            continue
+        bloco.append((nome, dados))
+        if len(bloco) >= _BENCH_DOCS_POR_ZIP:
+            n_zip += 1
+            _fechar_zip(n_zip, bloco)
+            bloco = []
+    if bloco:
+        n_zip += 1
+        _fechar_zip(n_zip, bloco)
+
+    man = {
+        "n_docs": n_docs,
+        "semente": semente,
+        "versao_gerador": _BENCH_VERSAO_GERADOR,
+        "xml": tot["xml"],
+        "bytes": tot["bytes"],
+        "ficheiros": ficheiros,
+    }
+    man_path.write_text(json.dumps(man), encoding="utf-8")
+    man["reutilizado"] = False
+    return man
 
 
-def _excel_bytes_dataframe_simples(df: pd.DataFrame, sheet: str = "SPED_sem_XML") -> bytes | None:
-    if df is None or df.empty:
-        return None
+def _bench_rss_pico_mb():
+    """Pico de memória residente do processo (MB); None onde `resource` não existe (Windows)."""
     try:
-        buf = io.BytesIO()
-        with pd.ExcelWriter(buf, engine="openpyxl") as w:
-            df.to_excel(w, sheet_name=sheet[:31], index=False)
-        return buf.getvalue()
-    except Exception:
+        import resource
+    except ImportError:
         return None
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux devolve KiB; macOS devolve bytes.
+    return round(pico / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
 
 
-def _garimpo_pastas_candidatas_excel_sped_faltantes():
-    """Pastas onde tentar gravar o Excel (preferência: pasta indicada no 1.º passo → pai do espelho → dados da app)."""
-    candidatas = []
-    vistos = set()
-
-    def _add(caminho):
-        if caminho is None:
-            return
-        try:
-            p = Path(str(caminho).strip()).expanduser().resolve()
-            if p in vistos:
-                return
-            vistos.add(p)
-            candidatas.append(p)
-        except (OSError, ValueError):
-            pass
-
-    _add(st.session_state.get("garimpo_lote_save_resolved"))
-    _esp = st.session_state.get("garimpo_lote_espelho_root")
-    if _esp:
-        try:
-            _add(Path(str(_esp).strip()).expanduser().resolve().parent)
-        except (OSError, ValueError):
-            pass
-    try:
-        _add(Path(_GARIM_ROOT) / "SPED_relatorio_lote")
-    except Exception:
-        pass
-    try:
-        _add(Path(TEMP_UPLOADS_DIR) / "relatorios_sped")
-    except Exception:
-        pass
-    return candidatas
-
+def _bench_executar_tamanho(pasta, n_docs: int, semente: int, etapas, manter: bool, log=print) -> dict:
+    """Gera (ou reutiliza) o lote e mede cada etapa. Devolve o dict de resultados deste tamanho."""
+    cnpj = _BENCH_CNPJ_CLIENTE
+    pasta = Path(pasta)
+    etapas_out = {}
 
-def _garimpo_gravar_excel_sped_faltantes_em_pasta_utilizador(df: pd.DataFrame) -> Path | None:
-    """
-    Grava sempre que possível `SPED_chaves_sem_XML_no_lote.xlsx` numa pasta persistente.
-    Devolve o caminho completo do ficheiro gravado ou None.
-    """
-    if df is None or getattr(df, "empty", True):
-        return None
-    b = _excel_bytes_dataframe_simples(df, sheet="Faltantes_SPED")
-    if not b:
-        return None
-    nome = "SPED_chaves_sem_XML_no_lote.xlsx"
-    for pasta in _garimpo_pastas_candidatas_excel_sped_faltantes():
+    def _medir(nome, fn):
+        t0 = time.perf_counter()
         try:
-            pasta.mkdir(parents=True, exist_ok=True)
-            p = pasta / nome
-            with open(p, "wb") as wf:
-                wf.write(b)
-            return p.resolve()
-        except OSError:
-            continue
-    return None
-
-
-def _pasta_destino_sped_xml_para_gravar():
-    """Resolve pasta em session_state['sped_xml_dest_dir'] (caminho completo obrigatório)."""
-    raw = st.session_state.get("sped_xml_dest_dir")
-    s = (str(raw).strip().strip('"').strip("'") if raw is not None else "")
-    if not s:
-        return (
-            None,
-            "Indique a **pasta completa** onde gravar os XML (o campo não pode ficar em branco).",
-        )
-    _ew = _erro_caminho_windows_num_servidor_nao_windows(s)
-    if _ew:
-        return None, _ew
-    try:
-        p = Path(s).expanduser().resolve()
-    except (OSError, ValueError):
-        return None, "Caminho inválido. Use um caminho completo (ex.: D:\\Exportacoes\\XML_SPED)."
-    if p.exists() and not p.is_dir():
-        return (
-            None,
-            "Esse caminho já existe e não é uma pasta (é um ficheiro). Escolha outra pasta.",
-        )
-    try:
-        p.mkdir(parents=True, exist_ok=True)
-    except OSError as e:
-        return None, f"Não foi possível criar ou aceder à pasta: {e}"
-    return p, None
+            extra = fn() or {}
+            erro = None
+        except Exception as e:
+            extra, erro = {}, f"{type(e).__name__}: {e}"
+        seg = time.perf_counter() - t0
+        r = {"segundos": round(seg, 3), "rss_pico_mb": _bench_rss_pico_mb()}
+        r.update(extra)
+        if erro:
+            r["erro"] = erro
+        etapas_out[nome] = r
+        log(f"  {nome:<20} {seg:9.2f}s" + (f"  ERRO {erro}" if erro else ""))
+        return r
+
+    r_ger = _medir("gerar", lambda: _bench_gerar_lote(pasta / "lote", n_docs, semente))
+    n_xml = int(r_ger.get("xml") or 0)
+    r_ger.pop("ficheiros", None)
+    fontes = {
+        f.name: str(f)
+        for f in sorted((pasta / "lote").iterdir())
+        if f.is_file() and f.suffix.lower() in (".zip", ".xml")
+    }
 
+    st.session_state.clear()
+    st.session_state[SESSION_KEY_FONTES_XML_MEMORIA] = dict(fontes)
+    st.session_state["cnpj_widget"] = cnpj
 
-def gravar_xml_lote_filtrado_por_chaves_sped(cnpj_limpo: str, texto_sped: str, pasta_dest: Path):
-    """
-    Grava na pasta_dest os XML do lote atual cuja chave 44 consta em C100/D100 do SPED (campo CHV).
-    Devolve (n_ficheiros_gravados, n_chaves_sped_sem_xml_no_lote, mensagem_markdown).
-    """
-    if not texto_sped or not str(texto_sped).strip():
-        return 0, 0, "Ficheiro SPED vazio."
-    chaves_ord = _sped_chaves44_de_texto(texto_sped)
-    ch_set = set(chaves_ord)
-    if not ch_set:
-        return (
-            0,
-            0,
-            "Nenhuma chave de 44 dígitos encontrada nos blocos C100/D100 (confirme que o .txt é EFD ICMS/IPI e tem CHV).",
-        )
-    if not _garimpo_existem_fontes_xml_lote():
-        return (
-            0,
-            len(ch_set),
-            "Não há XML do lote em memória/pasta — faça o **garimpo** primeiro e mantenha os ficheiros acessíveis.",
-        )
+    def _extrair():
+        n = b = 0
+        for nome, caminho in fontes.items():
+            with open(caminho, "rb") as fh:
+                for _name, data in extrair_recursivo(fh, nome):
+                    n += 1
+                    b += len(data)
+        return {"xml": n, "mb": round(b / 1e6, 1)}
 
-    pairs, matched_ch, ch_set, erros = _extrair_pares_xml_intersecao_sped_lote(
-        cnpj_limpo, texto_sped
-    )
-    count = 0
-    try:
-        pasta_dest.mkdir(parents=True, exist_ok=True)
-    except OSError as e:
-        return 0, len(ch_set), f"Não foi possível usar a pasta: {e}"
+    def _identificar():
+        n = 0
+        t_id = 0.0
+        for nome, caminho in fontes.items():
+            with open(caminho, "rb") as fh:
+                for name, data in extrair_recursivo(fh, nome):
+                    t0 = time.perf_counter()
+                    identify_xml_info(data, cnpj, name)
+                    t_id += time.perf_counter() - t0
+                    n += 1
+        return {"xml": n, "segundos_so_identify": round(t_id, 3)}
+
+    def _identificar_por_tipo():
+        # Mesmo percurso de `_identificar`, com o tempo de cada documento somado pelo tipo identificado
+        # (inutilizações e eventos de cancelamento à parte do modelo) — revela regressões num só tipo.
+        por_tipo = defaultdict(lambda: [0, 0.0])
+        for nome, caminho in fontes.items():
+            with open(caminho, "rb") as fh:
+                for name, data in extrair_recursivo(fh, nome):
+                    t0 = time.perf_counter()
+                    res, _is_p = identify_xml_info(data, cnpj, name)
+                    dt = time.perf_counter() - t0
+                    if res is None:
+                        tipo = "Outros"
+                    elif res["Status"] == "INUTILIZADOS":
+                        tipo = "Inutilização"
+                    elif res["Status"] == "CANCELADOS":
+                        tipo = "Evento"
+                    else:
+                        tipo = res["Tipo"]
+                    por_tipo[tipo][0] += 1
+                    por_tipo[tipo][1] += dt
+        n = sum(v[0] for v in por_tipo.values())
+        return {
+            "xml": n,
+            "segundos_so_identify": round(sum(v[1] for v in por_tipo.values()), 3),
+            "por_tipo": {
+                t: {"xml": q, "segundos": round(seg, 3), "us_por_doc": round(seg * 1e6 / q, 1)}
+                for t, (q, seg) in sorted(por_tipo.items())
+            },
+        }
 
-    for arc, raw in pairs:
+    def _garimpo():
+        antes = os.environ.get("GARIMPEIRO_CACHE_IDENT")
+        os.environ["GARIMPEIRO_CACHE_IDENT"] = "0"
         try:
-            dest = pasta_dest / arc
-            with open(dest, "wb") as wf:
-                wf.write(raw if isinstance(raw, (bytes, bytearray)) else bytes(raw))
-            count += 1
-        except OSError as e:
-            erros.append(str(e))
-
-    n_falt_sped = len(ch_set - matched_ch)
-    msg = (
-        f"Gravados **{count}** ficheiro(s) em `{pasta_dest}`. "
-        f"No SPED (C100/D100): **{len(ch_set)}** chave(s) de 44 dígitos; "
-        f"com XML no lote e gravadas: **{len(matched_ch)}**."
-    )
-    if n_falt_sped:
-        msg += f" **{n_falt_sped}** chave(s) do SPED **sem** ficheiro correspondente no lote atual."
-    if erros:
-        msg += f" Erros ao gravar (amostra): {erros[:3]}"
-    return count, n_falt_sped, msg
+            st.session_state["relatorio"] = []
+            ok, msg = reprocessar_garimpeiro_a_partir_do_disco(cnpj)
+        finally:
+            if antes is None:
+                os.environ.pop("GARIMPEIRO_CACHE_IDENT", None)
+            else:
+                os.environ["GARIMPEIRO_CACHE_IDENT"] = antes
+        if not ok:
+            raise RuntimeError(str(msg))
+        out = {}
+        for k in ("df_geral", "df_faltantes", "df_canceladas", "df_inutilizadas"):
+            df = st.session_state.get(k)
+            out[f"linhas_{k[3:]}"] = 0 if df is None else int(len(df))
+        return out
 
+    def _reconstruir():
+        st.session_state.pop(SESSION_KEY_RELATORIO_INCREMENTAL, None)
+        reconstruir_dataframes_relatorio_simples()
+        return {}
 
-def _zip_bytes_from_arc_pairs(pairs: list) -> bytes:
-    """Um único .zip em memória a partir de [(nome_interno, bytes), …]."""
-    if not pairs:
-        return b""
-    buf = io.BytesIO()
-    with zipfile.ZipFile(
-        buf,
-        "w",
-        zipfile.ZIP_DEFLATED,
-        compresslevel=_zip_export_compresslevel(),
-    ) as zf:
-        for arc, raw in pairs:
-            zf.writestr(arc, raw if isinstance(raw, (bytes, bytearray)) else bytes(raw))
-    return buf.getvalue()
+    def _df_geral():
+        df = st.session_state.get("df_geral")
+        if df is None or df.empty:
+            raise RuntimeError("df_geral vazio — a etapa «garimpo» falhou ou não correu.")
+        return df
 
+    def _excel():
+        caminho = excel_relatorio_geral_com_dashboard_ficheiro(_df_geral(), incluir_painel_fiscal=False)
+        try:
+            return {"mb": round((os.path.getsize(caminho) if caminho else 0) / 1e6, 2)}
+        finally:
+            _excel_fonte_descartar(caminho)
 
-def _intervalo_mes_relatorio(ano, mes):
-    try:
-        a, m = int(ano), int(mes)
-        if a < 1900 or not (1 <= m <= 12):
-            return None, None
-        d1 = date(a, m, 1)
-        d2 = date(a, m, monthrange(a, m)[1])
-        return d1, d2
-    except (TypeError, ValueError):
-        return None, None
+    def _saida(nome):
+        d = pasta / nome
+        shutil.rmtree(d, ignore_errors=True)
+        d.mkdir(parents=True, exist_ok=True)
+        return d
+
+    def _zip_pacote():
+        df = _df_geral()
+        d = _saida("saida_pacote")
+        paths, _x, matched, _aviso, _solta = _v2_export_pacote_contab_por_dimensoes(
+            d, "bench", set(df["Chave"].astype(str)), cnpj, None, _PACOTE_CONTAB_NOME_EXCEL_RAIZ, df
+        )
+        return {"zips": len(paths), "xml": int(matched), "mb": round(_bench_tamanho_pasta(d) / 1e6, 1)}
+
+    def _zip_etapa3():
+        df = _df_geral()
+        d = _saida("saida_etapa3")
+        org, todos, matched, aviso, _solta = _v2_export_zip_etapa3(
+            df,
+            xml_respeita_filtro=False,
+            excel_um_so_completo=True,
+            df_excel_completo=df,
+            v2_zip_org=True,
+            v2_zip_plano=True,
+            cnpj_limpo=cnpj,
+            zip_output_dir=str(d),
+            df_excel_todas_notas=df,
+        )
+        if aviso and str(aviso).startswith("ERR:"):
+            raise RuntimeError(str(aviso)[4:])
+        return {"zips": len(org) + len(todos), "xml": int(matched), "mb": round(_bench_tamanho_pasta(d) / 1e6, 1)}
+
+    passos = (
+        ("extrair_recursivo", _extrair),
+        ("identify_xml_info", _identificar),
+        ("identify_por_tipo", _identificar_por_tipo),
+        ("garimpo", _garimpo),
+        ("reconstruir", _reconstruir),
+        ("excel", _excel),
+        ("zip_pacote", _zip_pacote),
+        ("zip_etapa3", _zip_etapa3),
+    )
+    for nome, fn in passos:
+        if etapas and nome not in etapas:
+            continue
+        _medir(nome, fn)
+        gc.collect()
+
+    if not manter:
+        for sub in ("saida_pacote", "saida_etapa3"):
+            shutil.rmtree(pasta / sub, ignore_errors=True)
+    for nome, r in etapas_out.items():
+        base = r.get("xml") if nome in ("extrair_recursivo", "identify_xml_info", "identify_por_tipo") else n_xml
+        if nome in ("identify_xml_info", "identify_por_tipo") and r.get("segundos_so_identify"):
+            r["docs_por_seg"] = round(base / r["segundos_so_identify"], 1)
+        elif base and r["segundos"] > 0 and nome != "gerar":
+            r["docs_por_seg"] = round(base / r["segundos"], 1)
+    total = sum(r["segundos"] for n, r in etapas_out.items() if n != "gerar")
+    return {
+        "n_docs": n_docs,
+        "xml": n_xml,
+        "segundos_total": round(total, 3),
+        "docs_por_seg": round(n_xml / total, 1) if total > 0 else None,
+        "rss_pico_mb": _bench_rss_pico_mb(),
+        "etapas": etapas_out,
+    }
 
 
-def _data_emissao_linha(row):
-    de = row.get("Data Emissão")
-    if de is not None and not (isinstance(de, float) and pd.isna(de)):
-        s = str(de).strip()[:10]
-        if len(s) >= 10 and s[4] == "-" and s[7] == "-":
+def _bench_tamanho_pasta(d) -> int:
+    tot = 0
+    for raiz, _dirs, fs in os.walk(d):
+        for f in fs:
             try:
-                return date.fromisoformat(s[:10])
-            except ValueError:
+                tot += os.path.getsize(os.path.join(raiz, f))
+            except OSError:
                 pass
-    return None
+    return tot
 
 
-def _linha_no_periodo(row, d_ini, d_fim):
-    d0 = _data_emissao_linha(row)
-    if d0 is not None:
-        return d_ini <= d0 <= d_fim
-    lo, hi = _intervalo_mes_relatorio(row.get("Ano"), row.get("Mes"))
-    if lo is None:
-        return False
-    return not (hi < d_ini or lo > d_fim)
+def garimpeiro_benchmark(tamanhos=_BENCH_TAMANHOS_PADRAO, pasta=None, semente: int = 42, etapas=None, manter=False, log=print) -> dict:
+    """
+    Corre o benchmark para cada tamanho (n.º de documentos) e devolve o relatório serializável em JSON:
+    versão (SHA-1 do app.py), ambiente e, por tamanho, docs/s, pico de RSS e tempo de parede por etapa.
+    Os lotes gerados ficam em ``pasta/lote_<n>/lote`` e são reutilizados entre corridas (mesma semente),
+    para que versões diferentes do app sejam medidas sobre os mesmos ficheiros.
+    """
+    import platform
+
+    base = Path(pasta) if pasta else Path(_garimpeiro_resolver_pasta_dados()) / "benchmark_garimpeiro"
+    base.mkdir(parents=True, exist_ok=True)
+    relatorio = {
+        "versao_app": _garim_app_assinatura(),
+        "versao_gerador": _BENCH_VERSAO_GERADOR,
+        "semente": semente,
+        "python": platform.python_version(),
+        "plataforma": platform.platform(),
+        "cpus": os.cpu_count(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "data": datetime.now().isoformat(timespec="seconds"),
+        "resultados": [],
+    }
+    for n in tamanhos:
+        log(f"[benchmark] {n} documentos")
+        relatorio["resultados"].append(
+            _bench_executar_tamanho(base / f"lote_{n}", int(n), semente, etapas, manter, log=log)
+        )
+    return relatorio
 
 
-def _chave44_de_linha(row):
-    ch = row.get("Chave")
-    if ch is None or (isinstance(ch, float) and pd.isna(ch)):
-        return None
-    s = "".join(filter(str.isdigit, str(ch)))
-    if len(s) >= 44:
-        return s[:44]
-    return None
+def garimpeiro_benchmark_main(argv=None) -> int:
+    """Linha de comando do benchmark (ver `garimpeiro_benchmark`)."""
+    import argparse
 
+    ap = argparse.ArgumentParser(
+        prog="garimpeiro benchmark",
+        description="Benchmark do pipeline do Garimpeiro sobre lotes fiscais sintéticos.",
+    )
+    ap.add_argument(
+        "--tamanhos",
+        default=",".join(str(n) for n in _BENCH_TAMANHOS_PADRAO),
+        help="Números de documentos separados por vírgula (padrão: 10000,100000,1000000).",
+    )
+    ap.add_argument("--json", dest="json_saida", default="", help="Grava o relatório neste ficheiro JSON.")
+    ap.add_argument("--pasta", default="", help="Pasta de trabalho (lotes gerados e saídas).")
+    ap.add_argument("--semente", type=int, default=42)
+    ap.add_argument("--etapas", default="", help="Só estas etapas (vírgulas); «gerar» corre sempre.")
+    ap.add_argument("--manter", action="store_true", help="Não apaga os ZIP exportados no fim.")
+    a = ap.parse_args(argv)
+    try:
+        tamanhos = [int(x.replace("_", "")) for x in a.tamanhos.split(",") if x.strip()]
+    except ValueError:
+        ap.error("--tamanhos: use inteiros separados por vírgula.")
+    etapas = {e.strip() for e in a.etapas.split(",") if e.strip()} or None
+    _cli_silenciar_streamlit()
+    rel = garimpeiro_benchmark(
+        tamanhos, a.pasta or None, a.semente, etapas, a.manter, log=lambda m: print(m, file=sys.stderr)
+    )
+    txt = json.dumps(rel, ensure_ascii=False, indent=2)
+    if a.json_saida:
+        Path(a.json_saida).write_text(txt, encoding="utf-8")
+    else:
+        print(txt)
+    return 0 if not any("erro" in e for r in rel["resultados"] for e in r["etapas"].values()) else 1
 
-def _chave_para_conjunto_export(ch):
+
+# --- LINHA DE COMANDO (modo sem interface) ---
+# GARIMPEIRO_HEADLESS=1 python app.py garimpo --cnpj 00.000.000/0001-00 --fontes PASTA --saida PASTA
+#   [--sped EFD.txt] [--referencia grelha.xlsx --competencia 2024-03] [--sem-pdf] [--sem-pacote]
+# Sem servidor Streamlit, `st.session_state` é um dicionário do processo: a CLI usa-o como sessão de um
+# só garimpo (`_garimpo_sessao_headless`) e chama as mesmas funções da interface.
+
+_CLI_NOME_RESUMO = "resumo_garimpeiro.json"
+_CLI_NOME_EXCEL = "relatorio_garimpeiro.xlsx"
+_CLI_NOME_PDF = "dashboard_garimpeiro.pdf"
+_CLI_PASTA_PACOTE = "pacote_contabilidade"
+
+
+def _cli_silenciar_streamlit() -> None:
     """
-    Normaliza Chave para cruzar df_geral com identify_xml_info ao gerar ZIPs (Etapa 3).
-    Evita falhas por float/.0 na coluna, notação científica parcial ou espaços — casos em que
-    `res['Chave'] in set(df['Chave'])` nunca era verdadeiro.
+    Sem servidor, cada st.* avisa «missing ScriptRunContext» — ruído que esconde o progresso.
+    O Streamlit relê «logger.level» da config quando a analisa (tarde): fixa-se a opção e o nível.
+    Como o app corre como ``__main__``, os DeprecationWarning (ex.: fpdf2 ``ln=``) também apareceriam.
     """
-    if ch is None:
-        return None
+    import warnings
+
+    warnings.filterwarnings("ignore", category=DeprecationWarning)
     try:
-        if pd.isna(ch):
-            return None
-    except (TypeError, ValueError):
+        from streamlit import config as _st_config
+        import streamlit.logger as _st_logger
+
+        _st_config.set_option("logger.level", "error")
+        _st_logger.set_log_level("error")
+    except Exception:
         pass
-    t = str(ch).strip()
-    if not t or t.lower() == "nan":
-        return None
-    if t.startswith("INUT_"):
-        return t
-    d = "".join(filter(str.isdigit, t))
-    if len(d) >= 44:
-        return d[:44]
-    return None
 
 
-def _v2_extrai_chaves_44_do_texto(chave_raw: str) -> list:
-    """Blocos de exatamente 44 dígitos seguidos (como no menu do Garimpeiro Raiz)."""
-    if not chave_raw or not str(chave_raw).strip():
-        return []
-    brutas = re.findall(r"\d{44}", str(chave_raw))
-    visto, chaves = set(), []
-    for c in brutas:
-        if c not in visto:
-            visto.add(c)
-            chaves.append(c)
-    return chaves
+def _cli_fontes_de_pasta(pasta) -> dict:
+    """
+    {nome: caminho} de todos os .zip/.xml sob `pasta` (recursivo, ordem estável). Subpastas entram no nome
+    (``sub__lote.zip``) para não colidirem ficheiros homónimos.
+    """
+    base = Path(pasta)
+    if base.is_file():
+        return {base.name: str(base)} if base.suffix.lower() in (".zip", ".xml") else {}
+    out = {}
+    for raiz, dirs, fs in os.walk(base):
+        dirs.sort()
+        for f in sorted(fs):
+            if not f.lower().endswith((".zip", ".xml")):
+                continue
+            caminho = os.path.join(raiz, f)
+            rel = os.path.relpath(caminho, base)
+            out[rel.replace(os.sep, "__")] = caminho
+    return out
 
 
-def _v2_aplicar_nota_especifica_propria(
-    out_p: pd.DataFrame,
-    chave_raw,
-    numero_esp,
-    serie_raw,
-    *,
-    skip: bool = False,
-) -> pd.DataFrame:
-    """Restringe a chave(s) de 44 dígitos, INUT_… ou n.º + série (emissão própria ou terceiros)."""
-    if skip or out_p is None or out_p.empty or "Chave" not in out_p.columns:
-        return out_p
-    ch_raw = str(chave_raw or "")
-    ch_st = ch_raw.strip()
+def _cli_competencia(txt: str):
+    """«2024-03», «03/2024» ou «202403» → (ano, mês); None se não reconhecer."""
+    d = "".join(c for c in str(txt or "") if c.isdigit())
+    if len(d) != 6:
+        return None
+    ano, mes = (int(d[:4]), int(d[4:])) if int(d[:4]) > 1900 else (int(d[2:]), int(d[:2]))
+    return (ano, mes) if 1 <= mes <= 12 else None
 
-    chaves_44 = _v2_extrai_chaves_44_do_texto(ch_st)
-    ch_d_all = "".join(c for c in ch_st if c.isdigit())
-    if not chaves_44 and len(ch_d_all) >= 44:
-        chaves_44 = [ch_d_all[:44]]
 
-    if len(chaves_44) >= 1:
-        conj = set(chaves_44)
-        ck_norm = out_p["Chave"].map(_chave_para_conjunto_export)
-        return out_p.loc[ck_norm.isin(conj)]
+def _cli_ler_referencia(caminho) -> pd.DataFrame:
+    """Grelha de referência (Modelo, Série, Último número) em .xlsx/.xls ou .csv (separador detetado)."""
+    p = Path(caminho)
+    if p.suffix.lower() in (".xlsx", ".xlsm", ".xls"):
+        return pd.read_excel(p, dtype=str)
+    return pd.read_csv(p, sep=None, engine="python", dtype=str, encoding="utf-8-sig")
 
-    inuts = []
-    for line in ch_raw.splitlines():
-        lu = line.strip().upper()
-        if lu.startswith("INUT_") and len(lu) > 5:
-            inuts.append(lu)
-    inuts = list(dict.fromkeys(inuts))
-    if len(inuts) == 1:
-        return out_p.loc[out_p["Chave"].astype(str).str.strip().str.upper() == inuts[0]]
-    if len(inuts) > 1:
-        sset = set(inuts)
-        ck = out_p["Chave"].astype(str).str.strip().str.upper()
-        return out_p.loc[ck.isin(sset)]
 
+@contextmanager
+def _garimpo_sessao_headless(cnpj_limpo: str, saida: Path):
+    """
+    Sessão limpa para um garimpo sem interface: o CNPJ vai para `cnpj_widget` (como na lateral) e a pasta
+    de saída para `garimpo_lote_save_resolved` (onde o Excel «SPED sem XML» é gravado). No fim, o spool
+    da sessão é apagado e o estado limpo — o processo pode correr o garimpo seguinte.
+    """
+    st.session_state.clear()
+    st.session_state["cnpj_widget"] = cnpj_limpo
+    st.session_state["garimpo_lote_save_resolved"] = str(saida)
     try:
-        n = int(numero_esp)
-    except (TypeError, ValueError):
-        n = 0
-    ser = str(serie_raw or "").strip()
-    if ser and n > 0 and "Nota" in out_p.columns and "Série" in out_p.columns:
-        nn = pd.to_numeric(out_p["Nota"], errors="coerce")
-        ser_col = out_p["Série"].astype(str).str.strip()
-        mask = (nn == n) & (ser_col == ser)
-        if not mask.any() and ser.isdigit():
-            mask = (nn == n) & (pd.to_numeric(ser_col, errors="coerce") == int(ser))
-        return out_p.loc[mask]
-    return out_p
+        yield st.session_state
+    finally:
+        try:
+            _garimpo_limpar_fontes_xml_memoria_sessao()
+        except Exception:
+            pass
+        st.session_state.clear()
 
 
-def _nota_int_linha(row):
-    n = row.get("Nota")
-    if n is None or (isinstance(n, float) and pd.isna(n)):
-        return None
-    try:
-        return int(n)
-    except (ValueError, TypeError):
+def _cli_progresso_leitura(log, intervalo: float = 2.0):
+    """Ouvinte de `_garim_footer_render`: no máximo uma linha a cada `intervalo` s (e sempre a do último ficheiro)."""
+    ultimo = {"t": 0.0}
+
+    def _ouvir(cur, total, arquivo, fase, t_start):
+        agora = time.time()
+        if agora - ultimo["t"] < intervalo and cur != total:
+            return
+        ultimo["t"] = agora
+        log(f"[ler] {cur}/{total} {arquivo} · {fase} · {agora - (t_start or agora):.0f}s")
+
+    return _ouvir
+
+
+def garimpeiro_garimpo_headless(
+    cnpj,
+    fontes,
+    saida,
+    *,
+    sped=None,
+    referencia=None,
+    competencia=None,
+    excel: bool = True,
+    pdf: bool = True,
+    pacote: bool = True,
+    log=print,
+) -> dict:
+    """
+    Garimpo completo sem Streamlit: lê `fontes` (pasta ou ficheiro .zip/.xml), identifica, audita buracos
+    e grava em `saida` o Excel do relatório, o PDF do dashboard, o pacote contabilidade (ZIP por grupo) e,
+    com SPED, o Excel das chaves C100/D100 sem XML no lote. `referencia` é a grelha de últimos nº
+    (Modelo, Série, Último número) do mês `competencia`. Devolve o resumo (também gravado em
+    ``saida/resumo_garimpeiro.json``); ``resumo["ok"]`` é False se o garimpo ou alguma saída falhar.
+    """
+    cnpj_limpo = "".join(c for c in str(cnpj or "") if c.isdigit())[:14]
+    saida = Path(saida).expanduser().resolve()
+    resumo = {
+        "ok": False,
+        "cnpj": cnpj_limpo,
+        "fontes": str(fontes),
+        "saida": str(saida),
+        "versao_app": _garim_app_assinatura(),
+        "inicio": datetime.now().isoformat(timespec="seconds"),
+        "etapas": {},
+        "contagens": {},
+        "ficheiros": {},
+        "avisos": [],
+        "falhas": {},
+    }
+
+    def _gravar_resumo():
+        resumo["fim"] = datetime.now().isoformat(timespec="seconds")
         try:
-            return int(float(n))
-        except (ValueError, TypeError):
+            (saida / _CLI_NOME_RESUMO).write_text(
+                json.dumps(resumo, ensure_ascii=False, indent=2, default=str), encoding="utf-8"
+            )
+        except OSError:
+            pass
+        return resumo
+
+    def _etapa(nome, fn):
+        t0 = time.perf_counter()
+        try:
+            return fn()
+        except Exception as e:
+            resumo["falhas"][nome] = f"{type(e).__name__}: {e}"
+            log(f"[{nome}] ERRO {type(e).__name__}: {e}")
             return None
+        finally:
+            seg = time.perf_counter() - t0
+            resumo["etapas"][nome] = round(seg, 3)
+            log(f"[{nome}] {seg:.1f}s")
+
+    if len(cnpj_limpo) != 14:
+        resumo["erro"] = "CNPJ inválido (são precisos 14 dígitos)."
+        return resumo
+    mapa = _cli_fontes_de_pasta(fontes)
+    if not mapa:
+        resumo["erro"] = f"Nenhum .zip/.xml em {fontes}."
+        return resumo
+    saida.mkdir(parents=True, exist_ok=True)
+    resumo["n_ficheiros"] = len(mapa)
+
+    with _garimpo_sessao_headless(cnpj_limpo, saida) as sessao:
+        sessao[SESSION_KEY_FONTES_XML_MEMORIA] = mapa
+
+        if referencia:
+            comp = _cli_competencia(competencia)
+            if comp is None:
+                resumo["erro"] = "Com --referencia indique --competencia (AAAA-MM) do último nº da grelha."
+                return _gravar_resumo()
+            df_ref = _cli_ler_referencia(referencia)
+            ultimos = ref_map_from_dataframe(df_ref)
+            if not ultimos:
+                resumo["avisos"].append("Grelha de referência sem linhas válidas (Modelo, Série, Último número > 0).")
+            else:
+                sessao["seq_ref_rows"] = normalize_seq_ref_editor_df(_normalize_seq_ref_df_columns(df_ref))
+                sessao["seq_ref_ano"], sessao["seq_ref_mes"] = comp
+                sessao["seq_ref_ultimos"] = ultimos
+                resumo["referencia"] = {"competencia": f"{comp[0]}-{comp[1]:02d}", "series": len(ultimos)}
+
+        if sped:
+            _sped_guardar_na_sessao(Path(sped), Path(sped).name)
+
+        def _garimpo():
+            sessao["relatorio"] = []
+            ouvinte = _cli_progresso_leitura(log)
+            _GARIM_PROGRESSO_OUVINTES.append(ouvinte)
+            try:
+                return reprocessar_garimpeiro_a_partir_do_disco(cnpj_limpo)
+            finally:
+                _GARIM_PROGRESSO_OUVINTES.remove(ouvinte)
 
+        ok, msg = _etapa("garimpo", _garimpo) or (False, "falha na leitura do lote")
+        resumo["mensagem"] = str(msg)
+        if not ok:
+            resumo["erro"] = str(msg)
+            return _gravar_resumo()
+        sessao["garimpo_ok"] = True
+
+        df_geral = sessao.get("df_geral")
+        for k in (
+            "df_geral",
+            "df_resumo",
+            "df_faltantes",
+            "df_canceladas",
+            "df_inutilizadas",
+            "df_autorizadas",
+            "df_denegadas",
+            "df_rejeitadas",
+        ):
+            df = sessao.get(k)
+            resumo["contagens"][k[3:]] = 0 if df is None else int(len(df))
+        aviso_sped = sessao.get("_garimpo_aviso_sped_nao_lidas")
+        if sped:
+            resumo["sped"] = dict(aviso_sped or {"n_falt": 0})
+            if sessao.get(SPED_FALTANTES_XLSX_PATH_KEY):
+                resumo["ficheiros"]["sped_sem_xml"] = str(sessao[SPED_FALTANTES_XLSX_PATH_KEY])
 
-# CÃ³digo <mod> da Sefaz â†’ rótulo usado na coluna Modelo do relatório geral
-_MODELO_SEFAZ_PARA_RELATORIO = {
-    "55": "NF-e",
-    "65": "NFC-e",
-    "57": "CT-e",
-    "58": "MDF-e",
-    "67": "CT-e OS",
-}
+        if excel:
 
+            def _excel():
+                if not excel_relatorio_geral_com_dashboard_ficheiro(df_geral, saida / _CLI_NOME_EXCEL):
+                    raise RuntimeError("relatório geral vazio")
+                resumo["ficheiros"]["excel"] = str(saida / _CLI_NOME_EXCEL)
 
-def _normaliza_modelo_filtro(modelo):
-    """Aceita NF-e, NFC-e… ou 55, 65… (código Sefaz) para cruzar com df_geral."""
-    if modelo is None:
-        return ""
-    s = str(modelo).strip()
-    if not s:
-        return ""
-    if s in _MODELO_SEFAZ_PARA_RELATORIO:
-        return _MODELO_SEFAZ_PARA_RELATORIO[s]
-    try:
-        k = str(int(float(s.replace(",", "."))))
-        if k in _MODELO_SEFAZ_PARA_RELATORIO:
-            return _MODELO_SEFAZ_PARA_RELATORIO[k]
-    except (ValueError, TypeError):
-        pass
-    return s
+            _etapa("excel", _excel)
 
+        if pdf:
 
-def _normaliza_serie_filtro(serie):
-    """Alinha com a chave: série na app costuma vir sem zeros à esquerda (ex. 1 em vez de 001)."""
-    if serie is None or (isinstance(serie, float) and pd.isna(serie)):
-        return ""
-    if isinstance(serie, (int, float)) and not isinstance(serie, bool):
-        try:
-            f = float(serie)
-            if f.is_integer():
-                return str(int(f))
-        except (ValueError, OverflowError):
-            pass
-    t = str(serie).strip()
-    if not t:
-        return ""
-    try:
-        f = float(t.replace(",", "."))
-        if f.is_integer():
-            return str(int(f))
-    except ValueError:
-        pass
-    return t
+            def _pdf():
+                pb = pdf_dashboard_garimpeiro_bytes(
+                    coletar_kpis_dashboard(), format_cnpj_visual(cnpj_limpo), sessao.get("df_resumo")
+                )
+                if not pb:
+                    resumo["avisos"].append("PDF não gerado (instale fpdf2: pip install fpdf2).")
+                    return
+                (saida / _CLI_NOME_PDF).write_bytes(pb)
+                resumo["ficheiros"]["pdf"] = str(saida / _CLI_NOME_PDF)
 
+            _etapa("pdf", _pdf)
 
-def _modelo_serie_coincidem(row, modelo, serie):
-    m = row.get("Modelo")
-    s = row.get("Série")
-    if m is None or s is None:
-        return False
-    mn = _normaliza_modelo_filtro(modelo)
-    sn = _normaliza_serie_filtro(serie)
-    return (
-        str(m).strip() == mn
-        and _normaliza_serie_filtro(s) == sn
-    )
+        if pacote:
 
+            def _pacote():
+                pasta = saida / _CLI_PASTA_PACOTE
+                pasta.mkdir(parents=True, exist_ok=True)
+                zips, xm, aviso, xls = _v2_export_zip_mariana(
+                    df_geral, cnpj_limpo, zip_output_dir=pasta, zip_file_stem=f"pacote_{cnpj_limpo}"
+                )
+                if aviso and str(aviso).startswith("ERR:"):
+                    raise RuntimeError(str(aviso)[4:])
+                if aviso:
+                    resumo["avisos"].append(str(aviso))
+                resumo["contagens"]["xml_pacote"] = int(xm)
+                resumo["ficheiros"]["pacote"] = [str(z) for z in zips]
+                if xls:
+                    resumo["ficheiros"]["pacote_excel"] = str(xls)
 
-def chaves_por_periodo_data(df_geral, d_ini, d_fim):
-    if df_geral is None or df_geral.empty:
-        return []
-    df = df_geral
-    out = []
-    for _, row in df.iterrows():
-        if _linha_no_periodo(row, d_ini, d_fim):
-            ch = _chave44_de_linha(row)
-            if ch:
-                out.append(ch)
-    return list(dict.fromkeys(out))
+            _etapa("pacote", _pacote)
 
+        resumo["ok"] = not resumo["falhas"]
+    return _gravar_resumo()
 
-def chaves_por_faixa_numeracao(df_geral, modelo, serie, n_ini, n_fim):
-    if df_geral is None or df_geral.empty:
-        return []
-    df = df_geral
-    out = []
-    for _, row in df.iterrows():
-        if not _modelo_serie_coincidem(row, modelo, serie):
-            continue
-        ni = _nota_int_linha(row)
-        if ni is None or not (n_ini <= ni <= n_fim):
-            continue
-        ch = _chave44_de_linha(row)
-        if ch:
-            out.append(ch)
-    return list(dict.fromkeys(out))
 
+def garimpeiro_cli_main(argv=None) -> int:
+    """
+    Entrada da linha de comando (GARIMPEIRO_HEADLESS=1 python app.py <comando> …):
+    ``garimpo`` — garimpo de um CNPJ com Excel / PDF / pacote contabilidade; ``clientes`` — vários CNPJ
+    (`garimpeiro_lote_clientes_main`); ``benchmark`` — ver `garimpeiro_benchmark_main`. Progresso em stdout;
+    o resumo JSON vai para a pasta de saída (e para stdout com ``--json``).
+    """
+    import argparse
+
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if argv and argv[0] == "benchmark":
+        return garimpeiro_benchmark_main(argv[1:])
+    if argv and argv[0] == "clientes":
+        return garimpeiro_lote_clientes_main(argv[1:])
+
+    ap = argparse.ArgumentParser(
+        prog="garimpeiro",
+        description="Garimpeiro sem interface. Comandos: garimpo (omissão), clientes, benchmark.",
+    )
+    ap.add_argument("comando", nargs="?", default="garimpo", choices=("garimpo",))
+    ap.add_argument("--cnpj", required=True, help="CNPJ do cliente (com ou sem pontuação).")
+    ap.add_argument("--fontes", required=True, help="Pasta (ou ficheiro) com os .zip/.xml do lote.")
+    ap.add_argument("--saida", required=True, help="Pasta onde gravar Excel, PDF, pacote e resumo.")
+    ap.add_argument("--sped", default="", help="SPED EFD (.txt) para cruzar C100/D100 com o lote.")
+    ap.add_argument("--referencia", default="", help="Grelha de últimos nº (.xlsx/.csv: Modelo, Série, Último número).")
+    ap.add_argument("--competencia", default="", help="Mês da grelha de referência (AAAA-MM).")
+    ap.add_argument("--sem-excel", action="store_true")
+    ap.add_argument("--sem-pdf", action="store_true")
+    ap.add_argument("--sem-pacote", action="store_true")
+    ap.add_argument("--json", action="store_true", help="Escreve também o resumo JSON no fim do stdout.")
+    a = ap.parse_args(argv)
+
+    _cli_silenciar_streamlit()
+    resumo = garimpeiro_garimpo_headless(
+        a.cnpj,
+        a.fontes,
+        a.saida,
+        sped=a.sped or None,
+        referencia=a.referencia or None,
+        competencia=a.competencia or None,
+        excel=not a.sem_excel,
+        pdf=not a.sem_pdf,
+        pacote=not a.sem_pacote,
+        log=lambda m: print(m, flush=True),
+    )
+    if a.json:
+        print(json.dumps(resumo, ensure_ascii=False, default=str))
+    elif resumo.get("erro"):
+        print(f"ERRO: {resumo['erro']}", file=sys.stderr)
+    return 0 if resumo.get("ok") else 1
 
-def chaves_por_nota_serie(df_geral, modelo, serie, nota):
-    if df_geral is None or df_geral.empty:
-        return []
-    df = df_geral
-    out = []
-    for _, row in df.iterrows():
-        if not _modelo_serie_coincidem(row, modelo, serie):
-            continue
-        ni = _nota_int_linha(row)
-        if ni is None or ni != nota:
-            continue
-        ch = _chave44_de_linha(row)
-        if ch:
-            out.append(ch)
-    return list(dict.fromkeys(out))
 
+# --- LOTE DE CLIENTES (vários CNPJ, modo sem interface) ---
+# GARIMPEIRO_HEADLESS=1 python app.py clientes --manifesto clientes.csv --estado PASTA [--workers N] [--memoria-mb MB]
+# Cada linha do manifesto (cnpj, fontes, saida [, sped, referencia, competencia]) é um garimpo completo
+# (`garimpeiro_garimpo_headless`) num processo próprio; o estado de cada trabalho fica em
+# ``PASTA/estado_clientes.json`` e uma nova corrida retoma só o que não acabou «ok». A cache de identificação
+# (SQLite na pasta de dados) é comum a todos os processos e não depende do CNPJ — os XML de terceiros
+# repetidos nas pastas de vários clientes são identificados uma vez.
 
-# Texto espelhado na área «copiar guia» (alinhar ao fluxo real da app)
-_TEXTO_GUIA_GARIMPEIRO_PC = """
-Garimpeiro — Manual em texto simples (para copiar)
+_LOTE_CLI_NOME_ESTADO = "estado_clientes.json"
+_LOTE_CLI_NOME_LOG = "garimpeiro_log.txt"
+_LOTE_CLI_MAX_TENTATIVAS = 3
+_LOTE_CLI_CAMPOS = ("cnpj", "fontes", "saida", "sped", "referencia", "competencia")
 
-=== O QUE É LIDO E O QUE RECEBE ===
-Dados extraídos dos XML (e cruzamentos opcionais):
-• Identificação do documento: chave de 44 dígitos, modelo/tipo, série, número, datas de emissão, valores, operação, UF, emitente e destinatário quando constam no ficheiro.
-• Classificação por linha: emissão própria (seu CNPJ como emitente) vs. terceiros (documentos recebidos).
-• Agregados: resumo por série (totais), lista geral, canceladas, inutilizadas, autorizadas, buracos na numeração (com ou sem referência «último nº + mês» na lateral).
-• Um mesmo número de nota pode ter vários ficheiros XML (ex.: NF-e + evento) — várias linhas com a mesma chave ou lógica equivalente.
 
-Ficheiros e descargas que pode obter:
-• Nesta página: tabelas e indicadores (KPI) sobre o lote atual.
-• Excel: relatório geral completo; em Etapa 3 — «só Excel» (lote inteiro ou só linhas filtradas); em «lista específica» — planilhas por chaves, faixa, período, etc. (ver botões dessa zona).
-• ZIP (Etapa 3): até 10 000 XML por parte; modos «tudo» (filtros não cortam XML) ou «filtrado» (só XML das linhas filtradas); estrutura em raiz ou por pastas. Em cada parte: pasta RELATORIO_GARIMPEIRO/ com Excel desse envio.
-• PDF: resumo visual do painel (se a biblioteca fpdf2 estiver disponível — mensagem na app se faltar).
-• Modelo Excel para inutilizadas declaradas manualmente (quando usar essa funcionalidade).
+def _lote_cli_workers() -> int:
+    """
+    Garimpos em simultâneo. Variável GARIMPEIRO_LOTE_WORKERS: N = N processos; em branco = automático
+    (metade dos núcleos, máx. 8). Cada processo identifica em série — o paralelismo está nos clientes.
+    """
+    raw = (os.environ.get("GARIMPEIRO_LOTE_WORKERS") or "").strip()
+    if raw:
+        try:
+            return max(1, min(int(raw), 64))
+        except ValueError:
+            return 1
+    return max(1, min((os.cpu_count() or 1) // 2, 8))
 
-=== GARIMPEIRO RAIZ (linha de comandos) vs. ESTA PÁGINA ===
-• **SPED EFD (.txt):** pode anexar no **opcional do primeiro passo** (com as planilhas) ou no **fim do painel direito** — **gravar XML na pasta**, **ZIP** (cruzamento SPED×lote) e **Excel** de pendências (só no SPED). O pacote «Apuração final» em ZIP (Garimpeiro Raiz CLI) é outro fluxo.
 
-=== MANUAL PASSO A PASSO ===
-1. Lateral: CNPJ do emitente (cliente) — só os 14 dígitos ou cole já mascarado; clique em Liberar operação.
-2. Envie ZIP ou XML soltos (grandes volumes são suportados).
-3. Iniciar grande garimpo e aguardar o processamento.
-4. Depois do primeiro resultado, pode acrescentar mais XML/ZIP no topo da página sem reiniciar o garimpo.
-5. (Opcional) Lateral «Último nº por série»: afeta só o cálculo de buracos — **só as séries que preencher e guardar**; âncora por último nº e mês. O garimpo e o resumo por série continuam totais. Sem Guardar referência válida, buracos usam todo o intervalo lido em emissão própria.
-6. Inutilizadas: a partir dos buracos, por planilha (Excel/CSV) ou faixa — só números que já forem buraco listado (não alarga intervalos).
-7. Painel à direita: **Processar Dados** grava XML/ZIP extra, aplica inutilizações «sem XML» (se configurou) e recalcula a partir da pasta de uploads.
-8. Etapa 3: filtros em cascata (emissão própria e terceiros em colunas separadas). Na caixa **Tipo de exportação** escolha ZIP (tudo ou filtrado, raiz ou pastas) ou Excel (lote completo ou só filtrado). Depois use **Gerar — sua empresa**, **Gerar — terceiros** ou **Gerar os dois lados**. **SPED:** anexe o `.txt` no **opcional** do 1.º passo ou no **fim do painel direito** — XML na pasta, **ZIP** e **Excel** de pendências. O menu completo da CLI Raiz tem outras opções.
-9. Lista específica (secção própria): exporte subconjuntos por chaves, faixa, período, série ou uma nota — em Excel e/ou ZIP conforme os botões apresentados.
+def _lote_cli_ler_manifesto(caminho) -> list:
+    """
+    Manifesto .json (lista de objetos) ou .csv (cabeçalho cnpj;fontes;saida[;sped;referencia;competencia],
+    separador detetado). Caminhos relativos contam a partir da pasta do manifesto. Devolve os trabalhos com
+    ``id`` estável (CNPJ + fontes + saída) — é por ele que o estado se retoma.
+    """
+    p = Path(caminho).expanduser().resolve()
+    if p.suffix.lower() == ".json":
+        linhas = json.loads(p.read_text(encoding="utf-8"))
+    else:
+        df = pd.read_csv(p, sep=None, engine="python", dtype=str, encoding="utf-8-sig", keep_default_na=False)
+        df.columns = [_seq_ref_fold(c) for c in df.columns]
+        linhas = df.to_dict("records")
+    trabalhos = []
+    vistos = set()
+    for i, ln in enumerate(linhas, 1):
+        job = {k: str(ln.get(k) or "").strip() for k in _LOTE_CLI_CAMPOS}
+        job["cnpj"] = "".join(c for c in job["cnpj"] if c.isdigit())[:14]
+        if len(job["cnpj"]) != 14 or not job["fontes"] or not job["saida"]:
+            raise ValueError(f"Manifesto, linha {i}: são precisos cnpj (14 dígitos), fontes e saida.")
+        for k in ("fontes", "saida", "sped", "referencia"):
+            if job[k]:
+                job[k] = str((p.parent / Path(job[k]).expanduser()).resolve())
+        job["id"] = hashlib.sha1(f"{job['cnpj']}|{job['fontes']}|{job['saida']}".encode()).hexdigest()[:12]
+        if job["id"] in vistos:
+            raise ValueError(f"Manifesto, linha {i}: trabalho repetido ({job['cnpj']} → {job['saida']}).")
+        vistos.add(job["id"])
+        trabalhos.append(job)
+    return trabalhos
+
+
+def _lote_cli_estado_ler(pasta: Path) -> dict:
+    try:
+        est = json.loads((pasta / _LOTE_CLI_NOME_ESTADO).read_text(encoding="utf-8"))
+        if isinstance(est, dict) and isinstance(est.get("trabalhos"), dict):
+            return est
+    except (OSError, ValueError):
+        pass
+    return {"trabalhos": {}}
 
-=== DICAS ===
-• Resetar sistema: limpa sessão e temporários ao mudar de cliente ou recomeçar.
-• Nos filtros, lista vazia = esse critério não restringe. Opções inválidas após mudar outro filtro são limpas automaticamente.
-• Nomes de modelos na app: NF-e, NFS-e, NFC-e, CT-e, CT-e OS (mod. 67), MDF-e, Outros (cartas de correção não são lidas).
-""".strip()
 
-_TEXTO_GUIA_GARIMPEIRO_WEB = """
-Garimpeiro — Manual em texto simples (para copiar)
+def _lote_cli_estado_gravar(pasta: Path, est: dict) -> None:
+    """Grava o estado (ficheiro .parcial + os.replace: um crash a meio nunca deixa JSON cortado)."""
+    est["atualizado"] = datetime.now().isoformat(timespec="seconds")
+    destino = pasta / _LOTE_CLI_NOME_ESTADO
+    tmp = destino.with_name(destino.name + ".parcial")
+    tmp.write_text(json.dumps(est, ensure_ascii=False, indent=2, default=str), encoding="utf-8")
+    os.replace(tmp, destino)
 
-=== O QUE É LIDO E O QUE RECEBE ===
-Dados extraídos dos XML (e cruzamentos opcionais):
-• Identificação do documento: chave de 44 dígitos, modelo/tipo, série, número, datas de emissão, valores, operação, UF, emitente e destinatário quando constam no ficheiro.
-• Classificação por linha: emissão própria (seu CNPJ como emitente) vs. terceiros (documentos recebidos).
-• Agregados: resumo por série (totais), lista geral, canceladas, inutilizadas, autorizadas, buracos na numeração (com ou sem referência «último nº + mês» na lateral).
-• Um mesmo número de nota pode ter vários ficheiros XML (ex.: NF-e + evento) — várias linhas com a mesma chave ou lógica equivalente.
 
-Ficheiros e descargas que pode obter:
-• Nesta página: tabelas e indicadores (KPI) sobre o lote atual.
-• Excel: relatório geral completo; em Etapa 3 — «só Excel» (lote inteiro ou só linhas filtradas); em «lista específica» — planilhas por chaves, faixa, período, etc. (ver botões dessa zona).
-• ZIP (Etapa 3): até 10 000 XML por parte; modos «tudo» (filtros não cortam XML) ou «filtrado» (só XML das linhas filtradas); estrutura em raiz ou por pastas. Em cada parte: pasta RELATORIO_GARIMPEIRO/ com Excel desse envio.
-• PDF: resumo visual do painel (se a biblioteca fpdf2 estiver disponível — mensagem na app se faltar).
-• Modelo Excel para inutilizadas declaradas manualmente (quando usar essa funcionalidade).
+def _lote_cli_limitar_memoria(memoria_mb) -> bool:
+    """
+    Limite de memória deste processo (só o trabalho que nele corre): RLIMIT_DATA no Linux (heap e mmap
+    privados — não conta as reservas de endereço das threads), RLIMIT_AS nos outros POSIX. Acima dele as
+    alocações falham com MemoryError. False se não houver `resource` (Windows) ou o SO recusar.
+    """
+    if not memoria_mb:
+        return False
+    try:
+        import resource
+    except ImportError:
+        return False
+    lim = getattr(resource, "RLIMIT_DATA", None) if sys.platform.startswith("linux") else None
+    if lim is None:
+        lim = resource.RLIMIT_AS
+    try:
+        n = int(float(memoria_mb) * 1024 * 1024)
+        _mole, duro = resource.getrlimit(lim)
+        if duro != resource.RLIM_INFINITY:
+            n = min(n, duro)
+        resource.setrlimit(lim, (n, duro))
+        return True
+    except (ValueError, OSError):
+        return False
 
-=== MANUAL PASSO A PASSO ===
-1. Lateral: CNPJ do emitente (cliente) — só os 14 dígitos ou cole já mascarado; clique em Liberar operação.
-2. Envie ZIP ou XML soltos (grandes volumes são suportados).
-3. Iniciar grande garimpo e aguardar o processamento.
-4. Depois do primeiro resultado, pode acrescentar mais XML/ZIP no topo da página sem reiniciar o garimpo.
-5. (Opcional) Lateral «Último nº por série»: afeta só o cálculo de buracos — **só as séries que preencher e guardar**; âncora por último nº e mês. O garimpo e o resumo por série continuam totais. Sem Guardar referência válida, buracos usam todo o intervalo lido em emissão própria.
-6. Inutilizadas: a partir dos buracos, por planilha (Excel/CSV) ou faixa — só números que já forem buraco listado (não alarga intervalos).
-7. Painel à direita: **Processar Dados** aplica inutilizações «sem XML» (se configurou) e recalcula o relatório.
-8. Etapa 3: filtros em cascata (emissão própria e terceiros em colunas separadas). Na caixa **Tipo de exportação** escolha ZIP ou Excel. Depois use **Gerar — sua empresa**, **Gerar — terceiros** ou **Gerar os dois lados**. **SPED:** anexe o `.txt` no **opcional** do 1.º passo ou no **fim do painel direito** — use **Descarregar** para obter **ZIP** e **Excel** de pendências no browser.
-9. Lista específica (secção própria): exporte subconjuntos por chaves, faixa, período, série ou uma nota — em Excel e/ou ZIP conforme os botões apresentados.
 
-=== DICAS ===
-• Resetar sistema: limpa sessão e temporários ao mudar de cliente ou recomeçar.
-• Nos filtros, lista vazia = esse critério não restringe. Opções inválidas após mudar outro filtro são limpas automaticamente.
-• Nomes de modelos na app: NF-e, NFS-e, NFC-e, CT-e, CT-e OS (mod. 67), MDF-e, Outros (cartas de correção não são lidas).
-""".strip()
+def _lote_cli_executar_trabalho(job: dict, memoria_mb) -> dict:
+    """Corre no processo do pool (um por trabalho): garimpo de um cliente, com log na pasta de saída."""
+    os.environ["GARIMPEIRO_IDENT_WORKERS"] = "1"
+    _cli_silenciar_streamlit()
+    limitado = _lote_cli_limitar_memoria(memoria_mb)
+    saida = Path(job["saida"])
+    saida.mkdir(parents=True, exist_ok=True)
+    with open(saida / _LOTE_CLI_NOME_LOG, "a", encoding="utf-8") as fh_log:
+
+        def _log(m):
+            fh_log.write(f"{datetime.now():%H:%M:%S} {m}\n")
+            fh_log.flush()
+
+        _log(f"— {job['cnpj']} · {job['fontes']}" + (f" · limite {memoria_mb} MB" if limitado else ""))
+        resumo = garimpeiro_garimpo_headless(
+            job["cnpj"],
+            job["fontes"],
+            saida,
+            sped=job.get("sped") or None,
+            referencia=job.get("referencia") or None,
+            competencia=job.get("competencia") or None,
+            log=_log,
+        )
+    resumo["rss_pico_mb"] = _bench_rss_pico_mb()
+    return resumo
 
 
-def texto_guia_garimpeiro() -> str:
-    """Texto do manual copiável: variantes Cloud vs PC local (sem referências a pastas D:\\ na Cloud)."""
-    if _streamlit_likely_community_cloud():
-        return _TEXTO_GUIA_GARIMPEIRO_WEB
-    return _TEXTO_GUIA_GARIMPEIRO_PC
+def garimpeiro_lote_clientes(manifesto, estado, *, workers=None, memoria_mb=None, log=print) -> dict:
+    """
+    Garimpo de todos os clientes do manifesto num pool de processos (spawn, um processo novo por trabalho —
+    o limite de memória e a RAM libertada no fim ficam por cliente). O estado de cada trabalho
+    (pendente / em_curso / ok / falhou / memoria / interrompido) grava-se em `estado` a cada mudança; ao
+    retomar, os «ok» saltam-se e os restantes voltam à fila. Um processo que morre (ex.: OOM killer) parte o
+    pool: os trabalhos em curso voltam à fila até `_LOTE_CLI_MAX_TENTATIVAS`. Devolve o estado final.
+    """
+    import multiprocessing
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+    from concurrent.futures.process import BrokenProcessPool
+
+    pasta = Path(estado).expanduser().resolve()
+    pasta.mkdir(parents=True, exist_ok=True)
+    trabalhos = _lote_cli_ler_manifesto(manifesto)
+    workers = max(1, int(workers or _lote_cli_workers()))
+    est = _lote_cli_estado_ler(pasta)
+    est["manifesto"] = str(Path(manifesto).expanduser().resolve())
+    est["ids"] = [job["id"] for job in trabalhos]
+    reg = est["trabalhos"]
+    fila = deque()
+    for job in trabalhos:
+        ent = reg.setdefault(job["id"], {"tentativas": 0})
+        ent.update({k: job[k] for k in ("cnpj", "fontes", "saida")})
+        if ent.get("estado") == "ok":
+            continue
+        ent["estado"] = "pendente"
+        ent["tentativas"] = 0
+        fila.append(job)
+    _lote_cli_estado_gravar(pasta, est)
+    n_ok = sum(1 for j in trabalhos if reg[j["id"]].get("estado") == "ok")
+    log(f"[clientes] {len(trabalhos)} trabalho(s): {n_ok} já concluído(s), {len(fila)} na fila · {workers} processo(s)")
+
+    def _fim(job, estado_final, **extra):
+        ent = reg[job["id"]]
+        ent.update(extra)
+        ent["estado"] = estado_final
+        ent["fim"] = datetime.now().isoformat(timespec="seconds")
+        try:
+            ent["segundos"] = round(time.time() - ent.pop("_t0"), 1)
+        except (KeyError, TypeError):
+            pass
+        _lote_cli_estado_gravar(pasta, est)
+        feitos = sum(1 for j in trabalhos if reg[j["id"]].get("estado") not in ("pendente", "em_curso"))
+        log(f"[clientes] {feitos}/{len(trabalhos)} {job['cnpj']} → {estado_final}" + (f" ({extra['erro']})" if extra.get("erro") else ""))
+
+    pool = None
+    em_voo = {}
+    try:
+        while fila or em_voo:
+            if pool is None:
+                pool = ProcessPoolExecutor(
+                    max_workers=workers, mp_context=multiprocessing.get_context("spawn"), max_tasks_per_child=1
+                )
+            while fila and len(em_voo) < workers:
+                job = fila.popleft()
+                ent = reg[job["id"]]
+                ent.update(estado="em_curso", inicio=datetime.now().isoformat(timespec="seconds"), _t0=time.time())
+                ent["tentativas"] = int(ent.get("tentativas") or 0) + 1
+                ent.pop("erro", None)
+                em_voo[pool.submit(_lote_cli_executar_trabalho, job, memoria_mb)] = job
+            _lote_cli_estado_gravar(pasta, est)
+            prontos, _ = wait(list(em_voo), return_when=FIRST_COMPLETED)
+            partido = False
+            for fut in prontos:
+                job = em_voo.pop(fut)
+                try:
+                    resumo = fut.result()
+                except BrokenProcessPool:
+                    partido = True
+                    if reg[job["id"]]["tentativas"] < _LOTE_CLI_MAX_TENTATIVAS:
+                        reg[job["id"]]["estado"] = "pendente"
+                        fila.append(job)
+                    else:
+                        _fim(job, "interrompido", erro="o processo terminou sem resposta (memória do sistema?)")
+                    continue
+                except Exception as e:
+                    _fim(job, "falhou", erro=f"{type(e).__name__}: {e}")
+                    continue
+                falhas = resumo.get("falhas") or {}
+                if resumo.get("ok"):
+                    estado_final = "ok"
+                elif any(str(v).startswith("MemoryError") for v in falhas.values()):
+                    estado_final = "memoria"
+                else:
+                    estado_final = "falhou"
+                erro = resumo.get("erro") or "; ".join(f"{k}: {v}" for k, v in falhas.items())
+                _fim(
+                    job,
+                    estado_final,
+                    resumo=str(Path(job["saida"]) / _CLI_NOME_RESUMO),
+                    contagens=resumo.get("contagens"),
+                    rss_pico_mb=resumo.get("rss_pico_mb"),
+                    **({"erro": erro} if erro else {}),
+                )
+            if partido:
+                # Os restantes futuros do pool partido também falham: voltam à fila e o pool recria-se.
+                for fut, job in list(em_voo.items()):
+                    em_voo.pop(fut)
+                    reg[job["id"]]["estado"] = "pendente"
+                    fila.appendleft(job)
+                pool.shutdown(wait=False, cancel_futures=True)
+                pool = None
+                _lote_cli_estado_gravar(pasta, est)
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+        for job in em_voo.values():
+            reg[job["id"]]["estado"] = "pendente"
+        _lote_cli_estado_gravar(pasta, est)
+    return est
+
+
+def garimpeiro_lote_clientes_main(argv=None) -> int:
+    """Linha de comando do lote de clientes (ver `garimpeiro_lote_clientes`)."""
+    import argparse
+
+    ap = argparse.ArgumentParser(
+        prog="garimpeiro clientes",
+        description="Garimpo de vários CNPJ em paralelo, com estado retomável.",
+    )
+    ap.add_argument("--manifesto", required=True, help="CSV/JSON: cnpj, fontes, saida [, sped, referencia, competencia].")
+    ap.add_argument("--estado", required=True, help="Pasta do estado (estado_clientes.json).")
+    ap.add_argument("--workers", type=int, default=0, help="Processos em simultâneo (0 = automático).")
+    ap.add_argument("--memoria-mb", type=float, default=0, help="Limite de memória por trabalho (0 = sem limite).")
+    a = ap.parse_args(argv)
+    _cli_silenciar_streamlit()
+    try:
+        est = garimpeiro_lote_clientes(
+            a.manifesto,
+            a.estado,
+            workers=a.workers or None,
+            memoria_mb=a.memoria_mb or None,
+            log=lambda m: print(m, flush=True),
+        )
+    except (OSError, ValueError) as e:
+        print(f"ERRO: {e}", file=sys.stderr)
+        return 2
+    return 0 if all(est["trabalhos"][i].get("estado") == "ok" for i in est["ids"]) else 1
 
 
 if (__name__ == "__main__") and (not os.environ.get("GARIMPEIRO_HEADLESS")):
@@ -9435,7 +14751,7 @@ if (__name__ == "__main__") and (not os.environ.get("GARIMPEIRO_HEADLESS")):
                         st.warning(
                             "Preencha **documento**, **série** e **últ. nº** (> 0) em pelo menos um cartão e volte a guardar."
                         )
-                    if st.session_state.get("garimpo_ok") and st.session_state.get("relatorio"):
+                    if st.session_state.get("garimpo_ok") and _relatorio_len(st.session_state.get("relatorio")):
                         reconstruir_dataframes_relatorio_simples()
 
                 if st.session_state.get("seq_ref_ultimos"):
@@ -9445,7 +14761,7 @@ if (__name__ == "__main__") and (not os.environ.get("GARIMPEIRO_HEADLESS")):
                         f"**{len(st.session_state['seq_ref_ultimos'])}** série(s) a usar em buracos."
                     )
 
-            if st.session_state.get("garimpo_ok") and st.session_state.get("relatorio"):
+            if st.session_state.get("garimpo_ok") and _relatorio_len(st.session_state.get("relatorio")):
                 st.markdown("---")
                 st.markdown(
                     f'<h5>{_garim_emoji("\U0001f4c4")} PDF do dashboard</h5>',
@@ -9454,14 +14770,12 @@ if (__name__ == "__main__") and (not os.environ.get("GARIMPEIRO_HEADLESS")):
                 st.caption(
                     "Resumo do lote em PDF (métricas e amostras). Só descarrega o ficheiro — não altera o que vê nesta página."
                 )
-                _kpi_sb = coletar_kpis_dashboard()
                 _cnpj_sb = format_cnpj_visual(cnpj_limpo) if len(cnpj_limpo) == 14 else ""
-                _df_res_pdf = st.session_state.get("df_resumo")
-                _pdf_sb = pdf_dashboard_garimpeiro_bytes(_kpi_sb, _cnpj_sb, _df_res_pdf)
+                _pdf_sb = pdf_dashboard_garimpeiro_cache(_cnpj_sb)
                 if _pdf_sb:
-                    st.download_button(
+                    _st_download_ficheiro(
                         "\u2b07\ufe0f Baixar PDF do dashboard",
-                        data=_pdf_sb,
+                        _pdf_sb,
                         file_name="dashboard_garimpeiro.pdf",
                         mime="application/pdf",
                         key="dl_dash_pdf_sidebar",
@@ -10042,6 +15356,9 @@ if (__name__ == "__main__") and (not os.environ.get("GARIMPEIRO_HEADLESS")):
                     help="Obrigatório antes de gerar ZIP. Caminho completo (ex.: D:\\Exportacoes). A pasta é criada se não existir.",
                 )
 
+        if _garim_trabalho_ativo("zip_etapa3") is not None:
+            _dis_pr = _dis_tc = _dis_ambos = True
+            st.caption("Exportação ZIP em curso — acompanhe no painel de trabalhos acima.")
         col_g_pr, col_g_tc = st.columns(2, gap="large")
         with col_g_pr:
             gen_pr = st.button(
@@ -10271,69 +15588,95 @@ if (__name__ == "__main__") and (not os.environ.get("GARIMPEIRO_HEADLESS")):
                     if _err_zip_dir:
                         st.error(_err_zip_dir)
                     else:
-                        with st.spinner("A gerar ZIP…"):
-                            st.session_state["excel_buffer"] = None
-                            st.session_state.pop("excel_buffer_propria", None)
-                            st.session_state.pop("excel_buffer_terceiros", None)
-                            st.session_state.pop("export_excel_name_propria", None)
-                            st.session_state.pop("export_excel_name_terceiros", None)
-                            gc.collect()
-                            st.session_state["export_excel_name"] = (
-                                f"{_nome_arq}_relatorio_zip_{ts}.xlsx"
-                                if _nome_arq
-                                else f"relatorio_completo_{ts}.xlsx"
-                            )
+                        st.session_state["excel_buffer"] = None
+                        st.session_state.pop("excel_buffer_propria", None)
+                        st.session_state.pop("excel_buffer_terceiros", None)
+                        st.session_state.pop("export_excel_name_propria", None)
+                        st.session_state.pop("export_excel_name_terceiros", None)
+                        gc.collect()
+                        st.session_state["export_excel_name"] = (
+                            f"{_nome_arq}_relatorio_zip_{ts}.xlsx"
+                            if _nome_arq
+                            else f"relatorio_completo_{ts}.xlsx"
+                        )
+
+                        def _zip_trabalho(
+                            _pares=tuple(_pares_zip),
+                            _fmt=_fmt_run,
+                            _filt=_xml_filt,
+                            _dir=_path_zip_out,
+                            _nome=_zip_nome_raw,
+                            _cnpj=cnpj_limpo,
+                        ):
                             org_all = []
                             todos_all = []
-                            _err_zip = None
-                            for df_sl, ztag in _pares_zip:
+                            for df_sl, ztag in _pares:
                                 o, t, _xm, av, _ = _v2_export_zip_etapa3(
                                     df_sl,
-                                    xml_respeita_filtro=_xml_filt,
+                                    xml_respeita_filtro=_filt,
                                     df_filtrado_para_excel_bloco=(
-                                        df_sl if _xml_filt else None
-                                    ),
-                                    excel_um_so_completo=_fmt_run.startswith(
-                                        "zip_tudo"
+                                        df_sl if _filt else None
                                     ),
+                                    excel_um_so_completo=_fmt.startswith("zip_tudo"),
                                     df_excel_completo=df_sl,
-                                    v2_zip_org=_fmt_run.endswith("_pastas"),
-                                    v2_zip_plano=_fmt_run.endswith("_raiz"),
-                                    cnpj_limpo=cnpj_limpo,
+                                    v2_zip_org=_fmt.endswith("_pastas"),
+                                    v2_zip_plano=_fmt.endswith("_raiz"),
+                                    cnpj_limpo=_cnpj,
                                     zip_tag=ztag,
-                                    zip_output_dir=_path_zip_out,
-                                    zip_nome_ficheiro=_zip_nome_raw,
+                                    zip_output_dir=_dir,
+                                    zip_nome_ficheiro=_nome,
                                 )
                                 if av and str(av).startswith("ERR:"):
-                                    _err_zip = str(av)[4:].strip()
-                                    break
+                                    return {"erro": str(av)[4:].strip()}
                                 org_all.extend(o)
                                 todos_all.extend(t)
-                        if _err_zip:
-                            st.warning(_err_zip)
-                            st.session_state.pop("v2_export_sem_xml", None)
-                            st.session_state["org_zip_parts"] = []
-                            st.session_state["todos_zip_parts"] = []
-                            st.session_state["export_ready"] = False
-                            st.session_state["v2_etapa3_dual_export"] = False
-                            st.session_state.pop("v2_export_lados", None)
-                        else:
+                            return {"org": org_all, "todos": todos_all, "erro": None}
+
+                        # Assinatura dos filtros/lados **agora**: se mudarem enquanto o ZIP se gera, o ZIP fica
+                        # marcado como desatualizado em vez de passar pela seleção nova.
+                        def _zip_aplicar(
+                            tr,
+                            _fmt=_fmt_run,
+                            _lados=_lados_tuple,
+                            _sig=v2_assinatura_exportacao_sessao(),
+                        ):
                             st.session_state.pop("v2_export_sem_xml", None)
+                            r = tr["resultado"] if tr["estado"] == "concluido" else None
+                            if not r or r.get("erro"):
+                                if r and r.get("erro"):
+                                    tr["aviso"] = f"**{tr['rotulo']}** não gerou o ZIP — veja o aviso em baixo."
+                                    st.session_state["_garimpo_sync_feedback"] = (
+                                        "err",
+                                        r["erro"],
+                                    )
+                                st.session_state["org_zip_parts"] = []
+                                st.session_state["todos_zip_parts"] = []
+                                st.session_state["export_ready"] = False
+                                st.session_state["v2_etapa3_dual_export"] = False
+                                st.session_state.pop("v2_export_lados", None)
+                                return
                             st.session_state.update(
                                 {
-                                    "org_zip_parts": org_all
-                                    if _fmt_run.endswith("_pastas")
+                                    "org_zip_parts": r["org"]
+                                    if _fmt.endswith("_pastas")
                                     else [],
-                                    "todos_zip_parts": todos_all
-                                    if _fmt_run.endswith("_raiz")
+                                    "todos_zip_parts": r["todos"]
+                                    if _fmt.endswith("_raiz")
                                     else [],
                                     "export_ready": True,
                                     "v2_etapa3_dual_export": True,
-                                    "v2_export_lados": _lados_tuple,
-                                    "v2_export_sig": v2_assinatura_exportacao_sessao(),
+                                    "v2_export_lados": _lados,
+                                    "v2_export_sig": _sig,
                                 }
                             )
-                        gc.collect()
+                            gc.collect()
+
+                        _garim_trabalho_iniciar(
+                            "zip_etapa3",
+                            "Exportação ZIP (Etapa 3)",
+                            _zip_trabalho,
+                            ao_terminar=_zip_aplicar,
+                        )
                     st.rerun()
                 elif _xml_filt and df_all_f is not None and not df_all_f.empty:
                     if not _pares_zip:
@@ -10372,24 +15715,20 @@ if (__name__ == "__main__") and (not os.environ.get("GARIMPEIRO_HEADLESS")):
                         if _po_pr_pre or _pt_pr_pre:
                             for part in _po_pr_pre:
                                 _dl_k_zip[0] += 1
-                                if os.path.exists(part):
-                                    with open(part, "rb") as fp:
-                                        st.download_button(
-                                            rotulo_download_zip_parte(part),
-                                            fp.read(),
-                                            file_name=os.path.basename(part),
-                                            key=f"v2_dlo_p_{_dl_k_zip[0]}",
-                                        )
+                                _st_download_ficheiro(
+                                    rotulo_download_zip_parte(part),
+                                    part,
+                                    mime="application/zip",
+                                    key=f"v2_dlo_p_{_dl_k_zip[0]}",
+                                )
                             for part in _pt_pr_pre:
                                 _dl_k_zip[0] += 1
-                                if os.path.exists(part):
-                                    with open(part, "rb") as fp:
-                                        st.download_button(
-                                            rotulo_download_zip_parte(part),
-                                            fp.read(),
-                                            file_name=os.path.basename(part),
-                                            key=f"v2_dlt_p_{_dl_k_zip[0]}",
-                                        )
+                                _st_download_ficheiro(
+                                    rotulo_download_zip_parte(part),
+                                    part,
+                                    mime="application/zip",
+                                    key=f"v2_dlt_p_{_dl_k_zip[0]}",
+                                )
                         elif "propria" in _lados_ger:
                             st.caption("Nada a descarregar deste lado.")
                     if _xbp_pre:
@@ -10418,24 +15757,20 @@ if (__name__ == "__main__") and (not os.environ.get("GARIMPEIRO_HEADLESS")):
                         if _po_tc_pre or _pt_tc_pre:
                             for part in _po_tc_pre:
                                 _dl_k_zip[0] += 1
-                                if os.path.exists(part):
-                                    with open(part, "rb") as fp:
-                                        st.download_button(
-                                            rotulo_download_zip_parte(part),
-                                            fp.read(),
-                                            file_name=os.path.basename(part),
-                                            key=f"v2_dlo_t_{_dl_k_zip[0]}",
-                                        )
+                                _st_download_ficheiro(
+                                    rotulo_download_zip_parte(part),
+                                    part,
+                                    mime="application/zip",
+                                    key=f"v2_dlo_t_{_dl_k_zip[0]}",
+                                )
                             for part in _pt_tc_pre:
                                 _dl_k_zip[0] += 1
-                                if os.path.exists(part):
-                                    with open(part, "rb") as fp:
-                                        st.download_button(
-                                            rotulo_download_zip_parte(part),
-                                            fp.read(),
-                                            file_name=os.path.basename(part),
-                                            key=f"v2_dlt_t_{_dl_k_zip[0]}",
-                                        )
+                                _st_download_ficheiro(
+                                    rotulo_download_zip_parte(part),
+                                    part,
+                                    mime="application/zip",
+                                    key=f"v2_dlt_t_{_dl_k_zip[0]}",
+                                )
                         elif "terceiros" in _lados_ger:
                             st.caption("Nada a descarregar deste lado.")
                     if _xbt_pre:
@@ -10475,25 +15810,21 @@ if (__name__ == "__main__") and (not os.environ.get("GARIMPEIRO_HEADLESS")):
                     if _parts_o:
                         for part in _parts_o:
                             _dl_i += 1
-                            if os.path.exists(part):
-                                with open(part, "rb") as fp:
-                                    st.download_button(
-                                        rotulo_download_zip_parte(part),
-                                        fp.read(),
-                                        file_name=os.path.basename(part),
-                                        key=f"v2_dlo_{_dl_i}",
-                                    )
+                            _st_download_ficheiro(
+                                rotulo_download_zip_parte(part),
+                                part,
+                                mime="application/zip",
+                                key=f"v2_dlo_{_dl_i}",
+                            )
                     if _parts_t:
                         for part in _parts_t:
                             _dl_i += 1
-                            if os.path.exists(part):
-                                with open(part, "rb") as fp:
-                                    st.download_button(
-                                        rotulo_download_zip_parte(part),
-                                        fp.read(),
-                                        file_name=os.path.basename(part),
-                                        key=f"v2_dlt_{_dl_i}",
-                                    )
+                            _st_download_ficheiro(
+                                rotulo_download_zip_parte(part),
+                                part,
+                                mime="application/zip",
+                                key=f"v2_dlt_{_dl_i}",
+                            )
                 elif _xbuf or _xbp or _xbt:
                     st.caption("Ficheiros prontos abaixo.")
 
@@ -10673,32 +16004,28 @@ if (__name__ == "__main__") and (not os.environ.get("GARIMPEIRO_HEADLESS")):
             if _mmsg:
                 st.warning(_mmsg)
             _mxp = st.session_state.get("mariana_excel_completo_path")
-            if _mxp and os.path.isfile(_mxp):
-                with open(_mxp, "rb") as _xfe:
-                    _lbl_excel_mar = (
-                        "Excel completo (sem Painel Fiscal) — mesmo ficheiro da pasta"
-                        if _btn_pc
-                        else "Excel completo (sem Painel Fiscal)"
-                    )
-                    st.download_button(
-                        _lbl_excel_mar,
-                        _xfe.read(),
-                        file_name=os.path.basename(_mxp),
-                        key="v2_dl_mariana_excel_completo",
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                    )
+            if _mxp:
+                _lbl_excel_mar = (
+                    "Excel completo (sem Painel Fiscal) — mesmo ficheiro da pasta"
+                    if _btn_pc
+                    else "Excel completo (sem Painel Fiscal)"
+                )
+                _st_download_ficheiro(
+                    _lbl_excel_mar,
+                    _mxp,
+                    key="v2_dl_mariana_excel_completo",
+                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                )
             st.markdown("**Descarregar pacote (ZIP)**")
             for _i_m, part_m in enumerate(
                 st.session_state.get("mariana_zip_parts") or []
             ):
-                if os.path.exists(part_m):
-                    with open(part_m, "rb") as fm:
-                        st.download_button(
-                            f"Contabilidade · {rotulo_download_zip_parte(part_m)}",
-                            fm.read(),
-                            file_name=os.path.basename(part_m),
-                            key=f"v2_dl_mariana_{_i_m}",
-                        )
+                _st_download_ficheiro(
+                    f"Contabilidade · {rotulo_download_zip_parte(part_m)}",
+                    part_m,
+                    mime="application/zip",
+                    key=f"v2_dl_mariana_{_i_m}",
+                )
 
 
     def _garim_etapa3_fragment_entry():
@@ -10714,6 +16041,12 @@ if (__name__ == "__main__") and (not os.environ.get("GARIMPEIRO_HEADLESS")):
 
     if st.session_state.get("confirmado"):
         if not st.session_state.get("garimpo_ok"):
+            # A leitura do grande garimpo corre em segundo plano: ao terminar, o resultado passa à sessão aqui
+            # e a página troca para o relatório.
+            _garim_trabalhos_recolher()
+            if st.session_state.get("garimpo_ok"):
+                st.rerun()
+            _garim_trabalhos_painel()
             st.markdown(
                 f'<h5>{_garim_emoji("\U0001f4c4")} Documentos XML / ZIP para ler</h5>',
                 unsafe_allow_html=True,
@@ -10943,7 +16276,7 @@ O que esperar de cada modelo:
                 with st.expander("Detalhes de cada Modelo de extração", expanded=False):
                     st.markdown(_extracao_lote_expander_md)
             # Community Cloud: PASSO 3 oculto; ZIP e pastas ficam em «matriosca» (definição acima se a chave ainda não existir).
-            if st.button("INICIAR GRANDE GARIMPO"):
+            if st.button("INICIAR GRANDE GARIMPO", disabled=bool(_garim_trabalho_ativo("garimpo"))):
                 _ui_scroll_to_top()
                 # No mesmo rerun do clique o file_uploader por vezes devolve vazio — usar session_state (igual ao «Processar Dados»).
                 _ufs = uploaded_files
@@ -11043,9 +16376,7 @@ O que esperar de cada modelo:
                             )
                             st.stop()
 
-                    lote_dict = {}
                     progresso_bar = st.progress(0)
-                    status_text = st.empty()
                     total_arquivos = len(_ufs) if _ufs else max(1, _n_pasta_lote)
                     _garim_footer_render(
                         footer_bar,
@@ -11061,10 +16392,14 @@ O que esperar de cada modelo:
                         if _garimpo_analise_sem_pasta_local_projeto()
                         else "\u26cf\ufe0f Disco"
                     )
+                    # Só a cópia dos anexos fica nesta execução do script (os UploadedFile pertencem a ela);
+                    # a leitura do lote corre depois como trabalho em segundo plano.
                     with st.status(_lbl_status, expanded=True) as status_box:
 
+                        _n_spool_recusados = 0
                         if _ufs:
                             for i, f in enumerate(_ufs):
+                                progresso_bar.progress((i + 1) / max(total_arquivos, 1))
                                 _garim_footer_render(
                                     footer_bar,
                                     i + 1,
@@ -11073,15 +16408,17 @@ O que esperar de cada modelo:
                                     "Guardar",
                                     _t_garim,
                                 )
-                                raw = f.getvalue()
                                 key = _garimpo_nome_chave_upload(i, getattr(f, "name", None))
                                 if _garimpo_analise_sem_pasta_local_projeto():
-                                    _mem_lote[key] = raw
+                                    if not _garimpo_spool_gravar(_mem_lote, key, f):
+                                        _n_spool_recusados += 1
                                 else:
                                     caminho_salvo = os.path.join(TEMP_UPLOADS_DIR, key)
+                                    f.seek(0)
                                     with open(caminho_salvo, "wb") as out_f:
-                                        out_f.write(raw)
+                                        shutil.copyfileobj(f, out_f, _GARIMPO_SPOOL_BLOCO_COPIA)
                             _garimpo_descarta_upload_lote_xml_apos_copia()
+                            _garimpo_spool_aviso_recusados(_n_spool_recusados)
                         elif _n_pasta_lote:
                             _garim_footer_render(
                                 footer_bar,
@@ -11098,302 +16435,45 @@ O que esperar de cada modelo:
                             except Exception:
                                 os.makedirs(TEMP_UPLOADS_DIR, exist_ok=True)
                                 for _mk, _mraw in _mem_lote.items():
+                                    if isinstance(_mraw, str):
+                                        shutil.copyfile(_mraw, os.path.join(TEMP_UPLOADS_DIR, _mk))
+                                        continue
                                     with open(os.path.join(TEMP_UPLOADS_DIR, _mk), "wb") as out_f:
                                         out_f.write(_mraw)
 
                         lista_salvos = _lista_nomes_fontes_xml_garimpo()
-                        total_salvos = len(lista_salvos)
                         if _garimpo_escrita_espelho_final_continua_ativa():
                             _garimpo_hidratar_sped_sessao_do_widget_ini()
 
-                        for i, f_name in enumerate(lista_salvos):
-                            if i % 50 == 0: 
-                                gc.collect()
-
-                            progresso_bar.progress((i + 1) / max(total_salvos, 1))
-                            _fn_disp = (
-                                (str(f_name)[:56] + "…")
-                                if len(str(f_name)) > 58
-                                else str(f_name)
-                            )
-                            status_text.text(f"\u26cf\ufe0f {_fn_disp}")
-                            _garim_footer_render(
-                                footer_bar,
-                                i + 1,
-                                total_salvos,
-                                f_name,
-                                "Extrair",
-                                _t_garim,
-                            )
-
-                            try:
-                                with _abrir_fonte_xml_garimpo_stream(f_name) as file_obj:
-                                    todos_xmls = extrair_fonte_xml_garimpo(file_obj, f_name)
-                                    _inner_xml_n = 0
-                                    for name, xml_data in todos_xmls:
-                                        _inner_xml_n += 1
-                                        if (
-                                            _inner_xml_n % _GARIM_GRANDE_GARIMPO_REFRESH_XML_A_CADA
-                                            == 0
-                                        ):
-                                            _nk_live = len(lote_dict)
-                                            status_text.text(
-                                                f"\u26cf\ufe0f {_inner_xml_n} xml · {_nk_live} docs"
-                                            )
-                                            _garim_footer_render(
-                                                footer_bar,
-                                                i + 1,
-                                                total_salvos,
-                                                f_name,
-                                                f"{_inner_xml_n} xml · {_nk_live}",
-                                                _t_garim,
-                                            )
-                                        res, is_p = identify_xml_info(xml_data, cnpj_limpo, name)
-                                        if res:
-                                            key = res["Chave"]
-                                            if key in lote_dict:
-                                                if res["Status"] in [
-                                                    "CANCELADOS",
-                                                    "INUTILIZADOS",
-                                                    "DENEGADOS",
-                                                    "REJEITADOS",
-                                                ]:
-                                                    lote_dict[key] = (res, is_p)
-                                            else:
-                                                lote_dict[key] = (res, is_p)
-                                        del xml_data 
-                            except Exception as e: 
-                                continue
-
-                        status_box.update(label="\u2705 Pronto", state="complete", expanded=False)
+                        status_box.update(label="\u2705 Lote guardado", state="complete", expanded=False)
                         progresso_bar.empty()
-                        status_text.empty()
-                        _garim_footer_render(
-                            footer_bar,
-                            total_salvos,
-                            max(1, total_salvos),
-                            "—",
-                            "Resumo",
-                            _t_garim,
-                        )
-
-                    rel_list = []
-                    ref_ar, ref_mr, ref_map = buraco_ctx_sessao()
-                    audit_map = {}
-                    canc_list = []
-                    inut_list = []
-                    aut_list = []
-                    deneg_list = []
-                    rej_list = []
-                    geral_list = []
-
-                    for k, (res, is_p) in lote_dict.items():
-                        rel_list.append(res)
-
-                        if is_p:
-                            origem_label = f"EMISSÃO PRÓPRIA ({res['Operacao']})"
-                        else:
-                            origem_label = f"TERCEIROS ({res['Operacao']})"
-
-                        registro_base = {
-                            "Origem": origem_label, 
-                            "Operação": res["Operacao"], 
-                            "Modelo": res["Tipo"], 
-                            "Série": res["Série"], 
-                            "Nota": res["Número"], 
-                            "Data Emissão": res["Data_Emissao"],
-                            "CNPJ Emitente": res["CNPJ_Emit"], 
-                            "Nome Emitente": res["Nome_Emit"],
-                            "Doc Destinatário": res["Doc_Dest"], 
-                            "Nome Destinatário": res["Nome_Dest"],
-                            "UF Destino": res.get("UF_Dest") or "",
-                            "Chave": res["Chave"], 
-                            "Status Final": res["Status"], 
-                            "Valor": res["Valor"],
-                            "Ano": res["Ano"], 
-                            "Mes": res["Mes"]
-                        }
-
-                        if res["Status"] == "INUTILIZADOS":
-                            r = res.get("Range", (res["Número"], res["Número"]))
-                            for n in range(r[0], r[1] + 1):
-                                item_inut = registro_base.copy()
-                                item_inut.update({"Nota": n, "Status Final": "INUTILIZADA", "Valor": 0.0})
-                                geral_list.append(item_inut)
-                        else:
-                            geral_list.append(registro_base)
-
-                        if is_p:
-                            sk = (res["Tipo"], res["Série"])
-                            ult_u = ultimo_ref_lookup(ref_map, res["Tipo"], res["Série"])
-
-                            if res["Status"] == "INUTILIZADOS":
-                                r = res.get("Range", (res["Número"], res["Número"]))
-                                _man_inut = _inutil_sem_xml_manual(res)
-                                for n in range(r[0], r[1] + 1):
-                                    inut_list.append({"Modelo": res["Tipo"], "Série": res["Série"], "Nota": n})
-                                    if _incluir_em_resumo_por_serie(res, is_p, cnpj_limpo):
-                                        if sk not in audit_map:
-                                            audit_map[sk] = {"nums": set(), "nums_buraco": set(), "valor": 0.0}
-                                        audit_map[sk]["nums"].add(n)
-                                        if _man_inut or incluir_numero_no_conjunto_buraco(
-                                            res["Ano"], res["Mes"], n, ref_ar, ref_mr, ult_u
-                                        ):
-                                            audit_map[sk]["nums_buraco"].add(n)
-                            else:
-                                if res["Status"] == "DENEGADOS":
-                                    deneg_list.append(registro_base)
-                                elif res["Status"] == "REJEITADOS":
-                                    rej_list.append(registro_base)
-                                elif res["Número"] > 0:
-                                    if res["Status"] == "CANCELADOS":
-                                        canc_list.append(registro_base)
-                                    elif res["Status"] == "NORMAIS":
-                                        aut_list.append(registro_base)
-                                    if _incluir_em_resumo_por_serie(res, is_p, cnpj_limpo):
-                                        if sk not in audit_map:
-                                            audit_map[sk] = {"nums": set(), "nums_buraco": set(), "valor": 0.0}
-                                        audit_map[sk]["nums"].add(res["Número"])
-                                        if _cancel_sem_xml_manual(res):
-                                            audit_map[sk]["nums_buraco"].add(res["Número"])
-                                        elif incluir_numero_no_conjunto_buraco(
-                                            res["Ano"],
-                                            res["Mes"],
-                                            res["Número"],
-                                            ref_ar,
-                                            ref_mr,
-                                            ult_u,
-                                        ):
-                                            audit_map[sk]["nums_buraco"].add(res["Número"])
-                                        audit_map[sk]["valor"] += res["Valor"]
-
-                    if not rel_list:
-                        st.session_state["garimpo_ok"] = False
-                        if total_salvos == 0:
-                            st.error(
-                                "**Nenhum ficheiro** ficou no lote após o upload (lista interna vazia). "
-                                "Anexe de novo os XML/ZIP e tente outra vez; se usar apenas memória, confirme que não há erro de sessão."
-                            )
-                        else:
-                            st.error(
-                                f"**{total_salvos} ficheiro(s)** processados, mas **0 documentos** reconhecidos como NF-e/NFC-e. "
-                                "Confirme o **CNPJ** na barra (14 dígitos = **emitente** nos XML), que os ficheiros são XML de nota válidos "
-                                "e que os ZIP contêm `.xml` (não só PDF ou outro formato)."
-                            )
-                        try:
-                            _garim_footer_overlay_remove()
-                            footer_bar.empty()
-                        except Exception:
-                            pass
-                        st.stop()
-
-                    res_final = []
-                    fal_final = []
-
-                    for (t, s), dados in audit_map.items():
-                        ns = sorted(list(dados["nums"]))
-                        if ns:
-                            n_min = ns[0]
-                            n_max = ns[-1]
-                            res_final.append({
-                                "Documento": t, 
-                                "Série": s, 
-                                "Início": n_min, 
-                                "Fim": n_max, 
-                                "Quantidade": len(ns), 
-                                "Valor Contábil (R$)": round(dados["valor"], 2)
-                            })
-                        ult_lookup = ultimo_ref_lookup(ref_map, t, s) if ref_ar is not None else None
-                        fal_final.extend(
-                            falhas_buraco_por_serie(
-                                dados["nums_buraco"],
-                                t,
-                                s,
-                                ult_lookup,
-                                nums_existentes=dados["nums"],
-                            )
-                        )
-
-                    _sped_u_ini = st.session_state.get("sped_sessao_upload_ini")
-                    if _sped_u_ini is not None:
-                        try:
-                            _rsped_b = _sped_u_ini.read()
-                            try:
-                                _sped_u_ini.seek(0)
-                            except Exception:
-                                pass
-                            st.session_state[SPED_SESSION_TEXT_KEY] = _decode_sped_upload_bytes(
-                                _rsped_b
-                            ).strip()
-                            st.session_state[SPED_SESSION_NAME_KEY] = getattr(
-                                _sped_u_ini, "name", None
-                            ) or "SPED.txt"
-                        except Exception:
-                            pass
-
-                    _u_inut = up_ini_inut or st.session_state.get("garimpo_ini_inut")
-                    _u_canc = up_ini_canc or st.session_state.get("garimpo_ini_canc")
-                    _txt_inut_ini = str(
-                        st.session_state.get("garimpo_ini_inut_paste") or ""
-                    ).strip()
-                    _pl_ini = _garimpo_aplicar_planilhas_inutil_cancel_no_relatorio(
-                        rel_list,
-                        cnpj_limpo,
-                        pd.DataFrame(fal_final),
-                        _u_inut,
-                        _u_canc,
-                        texto_inut_colar=_txt_inut_ini or None,
-                    )
-                    if _pl_ini.get("msgs"):
-                        st.session_state["_garimpo_ini_avisos_planilhas"] = _pl_ini["msgs"]
-                    else:
-                        st.session_state.pop("_garimpo_ini_avisos_planilhas", None)
 
-                    st.session_state["relatorio"] = rel_list
-                    if (_pl_ini.get("inut", 0) + _pl_ini.get("canc", 0)) > 0:
-                        reconstruir_dataframes_relatorio_simples()
-                    else:
-                        st.session_state.update(
-                            {
-                                "df_resumo": pd.DataFrame(res_final),
-                                "df_faltantes": pd.DataFrame(fal_final),
-                                "df_canceladas": pd.DataFrame(canc_list),
-                                "df_inutilizadas": pd.DataFrame(inut_list),
-                                "df_autorizadas": pd.DataFrame(aut_list),
-                                "df_denegadas": pd.DataFrame(deneg_list),
-                                "df_rejeitadas": pd.DataFrame(rej_list),
-                                "df_geral": pd.DataFrame(geral_list),
-                                "st_counts": {
-                                    "CANCELADOS": len(canc_list),
-                                    "INUTILIZADOS": len(inut_list),
-                                    "AUTORIZADAS": len(aut_list),
-                                    "DENEGADOS": len(deneg_list),
-                                    "REJEITADOS": len(rej_list),
-                                },
-                            }
-                        )
-                        aplicar_compactacao_dfs_sessao()
-                        _garimpo_registar_aviso_sped_chaves_sem_xml_no_lote(
-                            st.session_state.get("df_geral"),
-                            str(st.session_state.get(SPED_SESSION_TEXT_KEY) or "").strip(),
-                        )
-                    if (
-                        st.session_state.get("garimpo_lote_espelho_root")
-                        and not _streamlit_likely_community_cloud()
-                    ):
-                        # 1 = mostrar relatório primeiro; 2 = gravar espelho no rerun seguinte
-                        st.session_state[SESSION_KEY_GARIMPO_ESPELHO_WRITE_PHASE] = 1
-                    st.session_state["garimpo_ok"] = True
-                    st.session_state["export_ready"] = False
-                    st.session_state["excel_buffer"] = None
                     try:
                         _garim_footer_overlay_remove()
                         footer_bar.empty()
                     except Exception:
                         pass
+                    if not lista_salvos:
+                        st.error(
+                            "**Nenhum ficheiro** ficou no lote após o upload (lista interna vazia). "
+                            "Anexe de novo os XML/ZIP e tente outra vez; se usar apenas memória, confirme que não há erro de sessão."
+                        )
+                        st.stop()
+                    _garim_trabalho_iniciar(
+                        "garimpo",
+                        "Grande garimpo",
+                        _garimpo_reler_lote_ler,
+                        cnpj_limpo,
+                        lista_salvos,
+                        ao_terminar=lambda tr, _c=cnpj_limpo, _n=lista_salvos, _ui=up_ini_inut, _uc=up_ini_canc: (
+                            _garim_trabalho_garimpo_aplicar(tr, _c, _n, _ui, _uc)
+                        ),
+                    )
                     st.rerun()
         else:
             # --- RESULTADOS TELA INICIAL (cartões por série só no PDF; aqui só tabela de resumo e abas) ---
+            _garim_trabalhos_recolher()
+            _garim_trabalhos_painel()
             _fb_sync = st.session_state.pop("_garimpo_sync_feedback", None)
             if _fb_sync:
                 _kind, _txt = _fb_sync
@@ -11416,57 +16496,35 @@ O que esperar de cada modelo:
                 )
             if _ph_esp == 2 and len(cnpj_limpo) == 14:
                 st.session_state.pop(SESSION_KEY_GARIMPO_ESPELHO_WRITE_PHASE, None)
-                with st.status(
-                    "A gravar espelho na pasta (pacote contabilidade)…",
-                    expanded=True,
-                ) as _st_grava_esp:
-                    st.warning(
-                        "**Enquanto esta mensagem estiver aberta:** não acrescente ficheiros ao lote, não altere status de notas "
-                        "(inutilizações, canceladas, etc.) nem carregue em **Processar dados** com mudanças nesse sentido — "
-                        "isso pode **encerrar** a gravação na pasta ou deixar os ficheiros **à meio**."
-                    )
-                    _ok_esp = _garimpo_gravar_espelho_layout_contabilidade(cnpj_limpo)
-                    _st_grava_esp.update(
-                        label=(
-                            "Espelho gravado na pasta."
-                            if _ok_esp
-                            else "Gravação na pasta terminou com problema — veja o aviso em baixo."
-                        ),
-                        state="complete",
-                        expanded=False,
-                    )
-                if _ok_esp and getattr(st, "toast", None):
-                    try:
-                        st.toast("Espelho gravado na pasta (pastas + ZIP).", icon="✅")
-                    except Exception:
-                        pass
-                elif not _ok_esp:
-                    _em = str(st.session_state.get("_garimpo_espelho_gravacao_erro") or "").strip()
-                    if _em:
-                        st.error(f"**Espelho na pasta:** {_em}")
+                if _garim_trabalho_iniciar(
+                    "espelho",
+                    "Gravação do espelho na pasta (pacote contabilidade)",
+                    _garimpo_gravar_espelho_layout_contabilidade,
+                    cnpj_limpo,
+                    ao_terminar=_garim_trabalho_espelho_aplicar,
+                ):
+                    st.rerun()
+            if _garim_trabalho_ativo("espelho") or _garim_trabalho_ativo("resync_espelho"):
+                st.warning(
+                    "**Enquanto a gravação na pasta corre:** não acrescente ficheiros ao lote, não altere status de notas "
+                    "(inutilizações, canceladas, etc.) nem carregue em **Processar dados** com mudanças nesse sentido — "
+                    "a pasta pode ficar **à meio** ou desalinhada do relatório."
+                )
 
             if st.session_state.get("garimpo_lote_save_resolved") and not _streamlit_likely_community_cloud():
                 if st.button(
                     "Atualizar arquivos salvos na pasta",
                     key="btn_garim_resync_espelho",
+                    disabled=bool(_garim_trabalho_ativo("resync_espelho") or _garim_trabalho_ativo("espelho")),
                     help="Só com pasta de destino definida no **passo 3**: relê todos os XML/ZIP do lote (incl. «Incluir mais»), recalcula tabelas — mantém inutilizadas/canceladas manuais sem XML — e regrava a subpasta do espelho (Garimpeiro_Local_…) já usada neste trabalho.",
                 ):
-                    footer_sync = st.empty()
-                    t0 = time.time()
-                    okp, msgp = reprocessar_garimpeiro_a_partir_do_disco(
-                        cnpj_limpo, footer_ph=footer_sync, t_start=t0
+                    _garim_trabalho_iniciar(
+                        "resync_espelho",
+                        "Reler o lote",
+                        _garim_trabalho_resync_espelho,
+                        cnpj_limpo,
+                        ao_terminar=lambda tr, _c=cnpj_limpo: _garim_trabalho_resync_aplicar(tr, _c),
                     )
-                    if okp:
-                        okr, msgr = _garimpo_resync_espelho_completo(cnpj_limpo)
-                        if okr:
-                            st.session_state["_garimpo_sync_feedback"] = ("ok", f"{msgp}\n\n{msgr}")
-                        else:
-                            st.session_state["_garimpo_sync_feedback"] = (
-                                "ok",
-                                f"{msgp}\n\n⚠ **Pasta:** {msgr}",
-                            )
-                    else:
-                        st.session_state["_garimpo_sync_feedback"] = ("err", msgp)
                     st.rerun()
 
             _gcm, _gcr = st.columns([2.95, 1.55], gap="large")
@@ -11492,15 +16550,15 @@ O que esperar de cada modelo:
                     f'<h3 class="garim-sec">{_garim_emoji("\U0001f4e5")} Terceiros — total por tipo</h3>',
                     unsafe_allow_html=True,
                 )
-                _rels_terc = [
-                    r
-                    for r in st.session_state["relatorio"]
-                    if "RECEBIDOS_TERCEIROS" in r.get("Pasta", "")
-                ]
-                if not _rels_terc:
+                _cnt_terc = Counter()
+                for (_pasta, _tipo), _q in _relatorio_contagem_pares(
+                    st.session_state["relatorio"], "Pasta", "Tipo"
+                ).items():
+                    if "RECEBIDOS_TERCEIROS" in (_pasta or ""):
+                        _cnt_terc[_tipo or "Outros"] += _q
+                if not _cnt_terc:
                     st.info("Nenhum XML de terceiros no lote.")
                 else:
-                    _cnt_terc = Counter((r.get("Tipo") or "Outros") for r in _rels_terc)
                     _df_terc = pd.DataFrame(
                         [{"Modelo": t, "Quantidade": n} for t, n in sorted(_cnt_terc.items(), key=lambda x: x[0])]
                     )
@@ -11531,12 +16589,20 @@ O que esperar de cada modelo:
                 df_ger = st.session_state.get("df_geral")
                 if not isinstance(df_ger, pd.DataFrame):
                     df_ger = pd.DataFrame()
+                # Subconjuntos memorizados por df_geral: o mesmo objecto a cada rerun mantém os índices das
+                # grelhas (`_aggrid_vista`) e as assinaturas dos downloads.
                 if df_ger.empty or "Origem" not in df_ger.columns:
-                    df_ger_p = df_ger.copy()
+                    df_ger_p = df_ger
                 else:
-                    df_ger_p = df_ger.loc[_mask_emissao_propria_df(df_ger)].reset_index(drop=True)
-                df_ger_t = _df_apenas_terceiros(df_ger)
-                _folhas_t = _folhas_detalhe_terceiros_do_subset(df_ger)
+                    df_ger_p = _df_memo_por_frame(
+                        df_ger,
+                        "relatorio_leitura_propria",
+                        lambda d: d.loc[_mask_emissao_propria_df(d)].reset_index(drop=True),
+                    )
+                df_ger_t = _df_memo_por_frame(df_ger, "relatorio_leitura_terceiros", _df_apenas_terceiros)
+                _folhas_t = _df_memo_por_frame(
+                    df_ger, "relatorio_leitura_folhas_terceiros", _folhas_detalhe_terceiros_do_subset
+                )
 
                 with st.expander(
                     "\U0001f3e2 Emissão própria — buracos, inutilizadas, canceladas, autorizadas, denegadas, rejeitadas e relatório geral",
@@ -11582,14 +16648,15 @@ O que esperar de cada modelo:
                                 )
                             df_b_f = _relatorio_leitura_tabela_aggrid(df_fal, "aggrid_rep_bur", height=420)
                             st.caption(f"**{len(df_b_f)}** linha(s) na vista (total na aba: {len(df_fal)}).")
-                            xlsx_b = _excel_bytes_memo("rep_bur", df_b_f, "Buracos")
+                            xlsx_b = _excel_ficheiro_memo(df_b_f, "Buracos")
                             if xlsx_b:
-                                st.download_button(
+                                _st_download_ficheiro(
                                     "Baixar Excel (vista filtrada)",
-                                    data=xlsx_b,
+                                    xlsx_b,
                                     file_name="relatorio_buracos.xlsx",
                                     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                                     key="dl_rep_buracos_xlsx",
+                                    regenerar=lambda _d=df_b_f: _excel_ficheiro_memo(_d, "Buracos"),
                                 )
                             _painel_zip_xml_filtrado("rep_bur", df_b_f, cnpj_limpo, df_ger)
                         else:
@@ -11599,14 +16666,15 @@ O que esperar de cada modelo:
                         if not df_inu.empty:
                             df_i_f = _relatorio_leitura_tabela_aggrid(df_inu, "aggrid_rep_inu", height=420)
                             st.caption(f"**{len(df_i_f)}** linha(s) na vista (total: {len(df_inu)}).")
-                            xlsx_i = _excel_bytes_memo("rep_inu", df_i_f, "Inutilizadas")
+                            xlsx_i = _excel_ficheiro_memo(df_i_f, "Inutilizadas")
                             if xlsx_i:
-                                st.download_button(
+                                _st_download_ficheiro(
                                     "Baixar Excel (vista filtrada)",
-                                    data=xlsx_i,
+                                    xlsx_i,
                                     file_name="relatorio_inutilizadas.xlsx",
                                     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                                     key="dl_rep_inut_xlsx",
+                                    regenerar=lambda _d=df_i_f: _excel_ficheiro_memo(_d, "Inutilizadas"),
                                 )
                             _painel_zip_xml_filtrado("rep_inu", df_i_f, cnpj_limpo, df_ger)
                         else:
@@ -11616,14 +16684,15 @@ O que esperar de cada modelo:
                         if not df_can.empty:
                             df_c_f = _relatorio_leitura_tabela_aggrid(df_can, "aggrid_rep_canc", height=420)
                             st.caption(f"**{len(df_c_f)}** linha(s) na vista (total: {len(df_can)}).")
-                            xlsx_c = _excel_bytes_memo("rep_canc", df_c_f, "Canceladas")
+                            xlsx_c = _excel_ficheiro_memo(df_c_f, "Canceladas")
                             if xlsx_c:
-                                st.download_button(
+                                _st_download_ficheiro(
                                     "Baixar Excel (vista filtrada)",
-                                    data=xlsx_c,
+                                    xlsx_c,
                                     file_name="relatorio_canceladas.xlsx",
                                     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                                     key="dl_rep_canc_xlsx",
+                                    regenerar=lambda _d=df_c_f: _excel_ficheiro_memo(_d, "Canceladas"),
                                 )
                             _painel_zip_xml_filtrado("rep_canc", df_c_f, cnpj_limpo, df_ger)
                         else:
@@ -11633,14 +16702,15 @@ O que esperar de cada modelo:
                         if not df_aut.empty:
                             df_a_f = _relatorio_leitura_tabela_aggrid(df_aut, "aggrid_rep_aut", height=420)
                             st.caption(f"**{len(df_a_f)}** linha(s) na vista (total: {len(df_aut)}).")
-                            xlsx_a = _excel_bytes_memo("rep_aut", df_a_f, "Autorizadas")
+                            xlsx_a = _excel_ficheiro_memo(df_a_f, "Autorizadas")
                             if xlsx_a:
-                                st.download_button(
+                                _st_download_ficheiro(
                                     "Baixar Excel (vista filtrada)",
-                                    data=xlsx_a,
+                                    xlsx_a,
                                     file_name="relatorio_autorizadas.xlsx",
                                     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                                     key="dl_rep_aut_xlsx",
+                                    regenerar=lambda _d=df_a_f: _excel_ficheiro_memo(_d, "Autorizadas"),
                                 )
                             _painel_zip_xml_filtrado("rep_aut", df_a_f, cnpj_limpo, df_ger)
                         else:
@@ -11650,14 +16720,15 @@ O que esperar de cada modelo:
                         if not df_den.empty:
                             df_d_f = _relatorio_leitura_tabela_aggrid(df_den, "aggrid_rep_den", height=420)
                             st.caption(f"**{len(df_d_f)}** linha(s) na vista (total: {len(df_den)}).")
-                            xlsx_d = _excel_bytes_memo("rep_den", df_d_f, "Denegadas")
+                            xlsx_d = _excel_ficheiro_memo(df_d_f, "Denegadas")
                             if xlsx_d:
-                                st.download_button(
+                                _st_download_ficheiro(
                                     "Baixar Excel (vista filtrada)",
-                                    data=xlsx_d,
+                                    xlsx_d,
                                     file_name="relatorio_denegadas.xlsx",
                                     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                                     key="dl_rep_den_xlsx",
+                                    regenerar=lambda _d=df_d_f: _excel_ficheiro_memo(_d, "Denegadas"),
                                 )
                             _painel_zip_xml_filtrado("rep_den", df_d_f, cnpj_limpo, df_ger)
                         else:
@@ -11667,14 +16738,15 @@ O que esperar de cada modelo:
                         if not df_rej.empty:
                             df_r_f = _relatorio_leitura_tabela_aggrid(df_rej, "aggrid_rep_rej", height=420)
                             st.caption(f"**{len(df_r_f)}** linha(s) na vista (total: {len(df_rej)}).")
-                            xlsx_r = _excel_bytes_memo("rep_rej", df_r_f, "Rejeitadas")
+                            xlsx_r = _excel_ficheiro_memo(df_r_f, "Rejeitadas")
                             if xlsx_r:
-                                st.download_button(
+                                _st_download_ficheiro(
                                     "Baixar Excel (vista filtrada)",
-                                    data=xlsx_r,
+                                    xlsx_r,
                                     file_name="relatorio_rejeitadas.xlsx",
                                     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                                     key="dl_rep_rej_xlsx",
+                                    regenerar=lambda _d=df_r_f: _excel_ficheiro_memo(_d, "Rejeitadas"),
                                 )
                             _painel_zip_xml_filtrado("rep_rej", df_r_f, cnpj_limpo, df_ger)
                         else:
@@ -11683,28 +16755,22 @@ O que esperar de cada modelo:
                     with tab_geral:
                         if not df_ger_p.empty:
                             df_g_f = _relatorio_leitura_tabela_aggrid(df_ger_p, "aggrid_rep_ger", height=480)
-                            _sig_f = _df_sig_hash_memo(df_g_f)
-                            _sig_full = _df_sig_hash_memo(df_ger_p)
+                            _sig_f = _df_sig_hash_frame(df_g_f)
+                            _sig_full = _df_sig_hash_frame(df_ger_p)
                             _full_vista = _sig_f == _sig_full and len(df_g_f) == len(df_ger_p)
                             st.caption(f"**{len(df_g_f)}** linha(s) na vista (total: {len(df_ger_p)}).")
                             if _full_vista:
-                                sk_wb = "_xlsx_mem_geral_workbook"
-                                prev_wb = st.session_state.get(sk_wb)
-                                if isinstance(prev_wb, tuple) and prev_wb[0] == _sig_full:
-                                    xlsx_g = prev_wb[1]
-                                else:
-                                    xlsx_g = excel_relatorio_geral_com_dashboard_bytes(df_ger_p)
-                                    if xlsx_g:
-                                        st.session_state[sk_wb] = (_sig_full, xlsx_g)
+                                xlsx_g = excel_relatorio_geral_com_dashboard_cache(df_ger_p)
                             else:
-                                xlsx_g = _excel_bytes_memo("rep_ger_filt", df_g_f, "Filtrado")
+                                xlsx_g = _excel_ficheiro_memo(df_g_f, "Filtrado")
                             if xlsx_g:
-                                st.download_button(
+                                _st_download_ficheiro(
                                     "Baixar Excel (completo + dashboard)" if _full_vista else "Baixar Excel (só filtrado)",
-                                    data=xlsx_g,
+                                    xlsx_g,
                                     file_name="relatorio_geral.xlsx",
                                     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                                     key="dl_rep_geral_xlsx",
+                                    regenerar=lambda _d=df_g_f: _excel_ficheiro_memo(_d, "Filtrado"),
                                 )
                             elif _full_vista:
                                 st.warning(_msg_sem_espaco_disco_garimpeiro())
@@ -11735,14 +16801,15 @@ O que esperar de cada modelo:
                         if not _tca.empty:
                             df_c_ft = _relatorio_leitura_tabela_aggrid(_tca, "aggrid_rep_canc_t", height=420)
                             st.caption(f"**{len(df_c_ft)}** linha(s) na vista (total: {len(_tca)}).")
-                            xlsx_ct = _excel_bytes_memo("rep_canc_t", df_c_ft, "Canceladas")
+                            xlsx_ct = _excel_ficheiro_memo(df_c_ft, "Canceladas")
                             if xlsx_ct:
-                                st.download_button(
+                                _st_download_ficheiro(
                                     "Baixar Excel (vista filtrada)",
-                                    data=xlsx_ct,
+                                    xlsx_ct,
                                     file_name="relatorio_terceiros_canceladas.xlsx",
                                     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                                     key="dl_rep_canc_xlsx_t",
+                                    regenerar=lambda _d=df_c_ft: _excel_ficheiro_memo(_d, "Canceladas"),
                                 )
                             _painel_zip_xml_filtrado("rep_canc_t", df_c_ft, cnpj_limpo, df_ger)
                         else:
@@ -11752,14 +16819,15 @@ O que esperar de cada modelo:
                         if not _tau.empty:
                             df_a_ft = _relatorio_leitura_tabela_aggrid(_tau, "aggrid_rep_aut_t", height=420)
                             st.caption(f"**{len(df_a_ft)}** linha(s) na vista (total: {len(_tau)}).")
-                            xlsx_at = _excel_bytes_memo("rep_aut_t", df_a_ft, "Autorizadas")
+                            xlsx_at = _excel_ficheiro_memo(df_a_ft, "Autorizadas")
                             if xlsx_at:
-                                st.download_button(
+                                _st_download_ficheiro(
                                     "Baixar Excel (vista filtrada)",
-                                    data=xlsx_at,
+                                    xlsx_at,
                                     file_name="relatorio_terceiros_autorizadas.xlsx",
                                     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                                     key="dl_rep_aut_xlsx_t",
+                                    regenerar=lambda _d=df_a_ft: _excel_ficheiro_memo(_d, "Autorizadas"),
                                 )
                             _painel_zip_xml_filtrado("rep_aut_t", df_a_ft, cnpj_limpo, df_ger)
                         else:
@@ -11769,14 +16837,15 @@ O que esperar de cada modelo:
                         if not _tde.empty:
                             df_d_ft = _relatorio_leitura_tabela_aggrid(_tde, "aggrid_rep_den_t", height=420)
                             st.caption(f"**{len(df_d_ft)}** linha(s) na vista (total: {len(_tde)}).")
-                            xlsx_dt = _excel_bytes_memo("rep_den_t", df_d_ft, "Denegadas")
+                            xlsx_dt = _excel_ficheiro_memo(df_d_ft, "Denegadas")
                             if xlsx_dt:
-                                st.download_button(
+                                _st_download_ficheiro(
                                     "Baixar Excel (vista filtrada)",
-                                    data=xlsx_dt,
+                                    xlsx_dt,
                                     file_name="relatorio_terceiros_denegadas.xlsx",
                                     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                                     key="dl_rep_den_xlsx_t",
+                                    regenerar=lambda _d=df_d_ft: _excel_ficheiro_memo(_d, "Denegadas"),
                                 )
                             _painel_zip_xml_filtrado("rep_den_t", df_d_ft, cnpj_limpo, df_ger)
                         else:
@@ -11786,14 +16855,15 @@ O que esperar de cada modelo:
                         if not _tre.empty:
                             df_r_ft = _relatorio_leitura_tabela_aggrid(_tre, "aggrid_rep_rej_t", height=420)
                             st.caption(f"**{len(df_r_ft)}** linha(s) na vista (total: {len(_tre)}).")
-                            xlsx_rt = _excel_bytes_memo("rep_rej_t", df_r_ft, "Rejeitadas")
+                            xlsx_rt = _excel_ficheiro_memo(df_r_ft, "Rejeitadas")
                             if xlsx_rt:
-                                st.download_button(
+                                _st_download_ficheiro(
                                     "Baixar Excel (vista filtrada)",
-                                    data=xlsx_rt,
+                                    xlsx_rt,
                                     file_name="relatorio_terceiros_rejeitadas.xlsx",
                                     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                                     key="dl_rep_rej_xlsx_t",
+                                    regenerar=lambda _d=df_r_ft: _excel_ficheiro_memo(_d, "Rejeitadas"),
                                 )
                             _painel_zip_xml_filtrado("rep_rej_t", df_r_ft, cnpj_limpo, df_ger)
                         else:
@@ -11802,31 +16872,22 @@ O que esperar de cada modelo:
                     with tab_ger_t:
                         if not df_ger_t.empty:
                             df_gt_f = _relatorio_leitura_tabela_aggrid(df_ger_t, "aggrid_rep_ger_t", height=480)
-                            _sig_ft = _df_sig_hash_memo(df_gt_f)
-                            _sig_full_t = _df_sig_hash_memo(df_ger_t)
+                            _sig_ft = _df_sig_hash_frame(df_gt_f)
+                            _sig_full_t = _df_sig_hash_frame(df_ger_t)
                             _full_vista_t = _sig_ft == _sig_full_t and len(df_gt_f) == len(df_ger_t)
                             st.caption(f"**{len(df_gt_f)}** linha(s) na vista (total: {len(df_ger_t)}).")
                             if _full_vista_t:
-                                sk_wb_t = "_xlsx_mem_geral_workbook_terc"
-                                prev_wb_t = st.session_state.get(sk_wb_t)
-                                _fd_t = _folhas_detalhe_terceiros_do_subset(df_ger)
-                                if isinstance(prev_wb_t, tuple) and prev_wb_t[0] == _sig_full_t:
-                                    xlsx_gt = prev_wb_t[1]
-                                else:
-                                    xlsx_gt = excel_relatorio_geral_com_dashboard_bytes(
-                                        df_ger_t, folhas_detalhe=_fd_t
-                                    )
-                                    if xlsx_gt:
-                                        st.session_state[sk_wb_t] = (_sig_full_t, xlsx_gt)
+                                xlsx_gt = excel_relatorio_geral_com_dashboard_cache(df_ger_t, folhas_detalhe=_folhas_t)
                             else:
-                                xlsx_gt = _excel_bytes_memo("rep_ger_filt_t", df_gt_f, "Filtrado")
+                                xlsx_gt = _excel_ficheiro_memo(df_gt_f, "Filtrado")
                             if xlsx_gt:
-                                st.download_button(
+                                _st_download_ficheiro(
                                     "Baixar Excel (completo + dashboard)" if _full_vista_t else "Baixar Excel (só filtrado)",
-                                    data=xlsx_gt,
+                                    xlsx_gt,
                                     file_name="relatorio_geral_terceiros.xlsx",
                                     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                                     key="dl_rep_geral_xlsx_t",
+                                    regenerar=lambda _d=df_gt_f: _excel_ficheiro_memo(_d, "Filtrado"),
                                 )
                             elif _full_vista_t:
                                 st.warning(_msg_sem_espaco_disco_garimpeiro())
@@ -12256,7 +17317,7 @@ O que esperar de cada modelo:
                     # =====================================================================
                     _manuais_undo = [
                         item
-                        for item in st.session_state["relatorio"]
+                        for item in _relatorio_iter_especiais(st.session_state["relatorio"])
                         if item.get("Arquivo") in ("REGISTRO_MANUAL", "REGISTRO_MANUAL_CANCELADO")
                     ]
                     if _manuais_undo:
@@ -12295,9 +17356,9 @@ O que esperar de cada modelo:
                                 if _chaves_sel:
                                     with st.spinner("A remover…"):
                                         _set_rem = set(_chaves_sel)
-                                        st.session_state["relatorio"] = [
-                                            i for i in st.session_state["relatorio"] if i["Chave"] not in _set_rem
-                                        ]
+                                        st.session_state["relatorio"] = _relatorio_sem_chaves(
+                                            st.session_state["relatorio"], _set_rem
+                                        )
                                         reconstruir_dataframes_relatorio_simples()
                                     st.rerun()
                                 else:
@@ -12656,15 +17717,13 @@ O que esperar de cada modelo:
                     for row in chunk_list(st.session_state["zip_dom_parts"], 3):
                         cols = st.columns(len(row))
                         for idx, part in enumerate(row):
-                            if os.path.exists(part):
-                                with open(part, "rb") as f_final:
-                                    cols[idx].download_button(
-                                        label=rotulo_download_zip_parte(part),
-                                        data=f_final.read(),
-                                        file_name=os.path.basename(part),
-                                        mime="application/zip",
-                                        key=f"btn_dl_dom_{part}",
-                                    )
+                            _st_download_ficheiro(
+                                rotulo_download_zip_parte(part),
+                                part,
+                                mime="application/zip",
+                                key=f"btn_dl_dom_{part}",
+                                alvo=cols[idx],
+                            )
 
             # =====================================================================
             # SPED — fim do painel direito (após EXPORTAR LISTA ESPECÍFICA)
@@ -12702,7 +17761,7 @@ O que esperar de cada modelo:
                         "Gravar XML do lote (interseção com chaves C100/D100)",
                         key="btn_sped_gravar_xml_pasta",
                     ):
-                        texto_sped = _sped_resolver_texto_de_uploader(sped_efd_up)
+                        texto_sped = _sped_resolver_fonte_de_uploader(sped_efd_up)
                         if not texto_sped:
                             st.warning(
                                 "Anexe o **.txt** do SPED aqui ou no **opcional do primeiro passo** (fica na sessão ao iniciar o garimpo)."
@@ -12731,7 +17790,7 @@ O que esperar de cada modelo:
                     "Gerar ZIP e Excel (exportação SPED)",
                     key="btn_sped_gera_zip_xlsx",
                 ):
-                    texto_sped = _sped_resolver_texto_de_uploader(sped_efd_up)
+                    texto_sped = _sped_resolver_fonte_de_uploader(sped_efd_up)
                     if not texto_sped:
                         st.warning(
                             "Anexe o **.txt** do SPED aqui ou use o do **opcional do 1.º passo** (sessão)."
@@ -12809,4 +17868,8 @@ O que esperar de cada modelo:
                     st.session_state.pop("sped_export_meta", None)
                     st.rerun()
     else:
-        st.warning("\U0001f448 Insira o CNPJ lateral para começar.")
\ No newline at end of file
+        st.warning("\U0001f448 Insira o CNPJ lateral para começar.")
+
+
+if (__name__ == "__main__") and os.environ.get("GARIMPEIRO_HEADLESS"):
+    sys.exit(garimpeiro_cli_main(sys.argv[1:]))
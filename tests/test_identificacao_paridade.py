@@ -0,0 +1,51 @@
+"""
+Paridade do `identify_xml_info` com a versão anterior (uma expressão regular por campo).
+
+`fixtures/identificacao/` tem um XML por modelo e tipo de evento (NF-e, NFC-e, CT-e, MDF-e, NFS-e,
+cancelamento 110111 e por cStat 101, carta de correção, inutilização de faixa e de número único,
+denegada 110/302, rejeitada, prefixo de namespace, assinatura base64). `esperado.json` guarda o
+resultado da versão por regex para o mesmo CNPJ de cliente; o teste compara campo a campo.
+
+Uso: GARIMPEIRO_HEADLESS=1 python -m pytest tests
+"""
+
+import json
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("GARIMPEIRO_HEADLESS", "1")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import app  # noqa: E402
+
+PASTA = Path(__file__).resolve().parent / "fixtures" / "identificacao"
+ESPERADO = json.loads((PASTA / "esperado.json").read_text(encoding="utf-8"))
+
+
+def _normalizar(resumo):
+    """Resumo comparável ao JSON: sem o «Conteúdo» (bytes) e com a faixa de inutilização em lista."""
+    if resumo is None:
+        return None
+    return {k: (list(v) if isinstance(v, tuple) else v) for k, v in resumo.items() if k != "Conteúdo"}
+
+
+@pytest.mark.parametrize("nome", sorted(ESPERADO["casos"]))
+def test_identify_xml_info_igual_a_versao_regex(nome):
+    esperado = ESPERADO["casos"][nome]
+    res, is_p = app.identify_xml_info((PASTA / nome).read_bytes(), ESPERADO["cnpj_cliente"], nome)
+    obtido = _normalizar(res)
+    if esperado["resumo"] is None:
+        assert obtido is None
+    else:
+        assert obtido is not None
+        for campo in sorted(set(esperado["resumo"]) | set(obtido)):
+            assert obtido.get(campo) == esperado["resumo"].get(campo), campo
+    assert bool(is_p) == esperado["is_p"]
+
+
+def test_corpus_cobre_todos_os_xml():
+    """Um XML novo em fixtures/ sem entrada em esperado.json não passaria em silêncio."""
+    assert sorted(p.name for p in PASTA.glob("*.xml")) == sorted(ESPERADO["casos"])